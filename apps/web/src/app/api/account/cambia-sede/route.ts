@@ -1,7 +1,7 @@
 import { cookies } from "next/headers";
 import { NextRequest, NextResponse } from "next/server";
 import { SESSION_COOKIE } from "@/lib/auth";
-import { workerFetch } from "@/lib/worker-config";
+import { forgetAccessToken, workerFetch } from "@/lib/worker-config";
 
 export async function POST(req: NextRequest) {
   const cookieStore = await cookies();
@@ -11,6 +11,8 @@ export async function POST(req: NextRequest) {
   const body = await req.json();
   try {
     const res = await workerFetch("POST", "/api/account/cambia-sede", token, { body: JSON.stringify(body) });
+    // Il token di accesso in cache porta la sede vecchia: il prossimo workerGet ne chiede uno nuovo.
+    if (res.ok) forgetAccessToken(token);
     const data = await res.json();
     return NextResponse.json(data, { status: res.status });
   } catch {
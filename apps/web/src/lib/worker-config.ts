@@ -22,6 +22,67 @@ export function workerHeaders(token: string, json = false): Record<string, strin
   return h;
 }
 
+// ─── Token di accesso firmati ─────────────────────────────────────────────────
+// Il worker scambia il token di sessione con un token firmato a vita breve
+// (POST /api/auth/access-token) che verifica senza query: i 6-7 workerGet
+// paralleli di una pagina non ripassano dalla validazione sessione su DB.
+// Cache per processo Next keyed sul token di sessione, con una sola emissione
+// in volo per sessione. Se il worker non li emette (sessioni legacy, chiave
+// non configurata) si resta sul token di sessione per un minuto, poi si riprova.
+type AccessEntry = { bearer: string; expiresAt: number };
+const accessTokens = new Map<string, AccessEntry>();
+const accessInFlight = new Map<string, Promise<string>>();
+const ACCESS_TOKEN_CACHE_MAX = 1000;
+const ACCESS_TOKEN_MARGIN_MS = 15_000;
+const ACCESS_TOKEN_RETRY_MS = 60_000;
+
+function rememberAccessToken(sessionToken: string, entry: AccessEntry) {
+  accessTokens.delete(sessionToken);
+  accessTokens.set(sessionToken, entry);
+  while (accessTokens.size > ACCESS_TOKEN_CACHE_MAX) {
+    const oldest = accessTokens.keys().next().value;
+    if (oldest === undefined) break;
+    accessTokens.delete(oldest);
+  }
+}
+
+async function mintAccessToken(sessionToken: string): Promise<string> {
+  try {
+    const res = await fetch(`${WORKER_URL}/api/auth/access-token`, {
+      method: "POST",
+      headers: workerHeaders(sessionToken),
+      cache: "no-store",
+      signal: AbortSignal.timeout(WORKER_TIMEOUT_MS),
+    });
+    if (res.ok) {
+      const data = (await res.json()) as { access_token: string; expires_at: number };
+      rememberAccessToken(sessionToken, { bearer: data.access_token, expiresAt: data.expires_at * 1000 });
+      return data.access_token;
+    }
+  } catch {
+    // worker irraggiungibile: la richiesta vera riportera' l'errore
+  }
+  rememberAccessToken(sessionToken, { bearer: sessionToken, expiresAt: Date.now() + ACCESS_TOKEN_RETRY_MS });
+  return sessionToken;
+}
+
+/** Bearer da usare verso il worker: token di accesso firmato se disponibile, altrimenti il token di sessione. */
+export async function getAccessToken(sessionToken: string): Promise<string> {
+  const cached = accessTokens.get(sessionToken);
+  if (cached && cached.expiresAt - ACCESS_TOKEN_MARGIN_MS > Date.now()) return cached.bearer;
+  let pending = accessInFlight.get(sessionToken);
+  if (!pending) {
+    pending = mintAccessToken(sessionToken).finally(() => accessInFlight.delete(sessionToken));
+    accessInFlight.set(sessionToken, pending);
+  }
+  return pending;
+}
+
+/** Scarta il token di accesso in cache (cambio sede, 401 dal worker). */
+export function forgetAccessToken(sessionToken: string) {
+  accessTokens.delete(sessionToken);
+}
+
 // ─── Risposte standard per i route handler ────────────────────────────────────
 export function unauthorized() {
   return NextResponse.json({ error: "Unauthorized" }, { status: 401 });
@@ -49,12 +110,21 @@ export async function workerGet<T>(path: string, context: string): Promise<T | n
   if (!token) return null;
 
   try {
-    const res = await fetch(`${WORKER_URL}${path}`, {
-      method: "GET",
-      headers: workerHeaders(token, true),
-      cache: "no-store",
-      signal: AbortSignal.timeout(WORKER_TIMEOUT_MS),
-    });
+    const get = (bearer: string) =>
+      fetch(`${WORKER_URL}${path}`, {
+        method: "GET",
+        headers: workerHeaders(bearer, true),
+        cache: "no-store",
+        signal: AbortSignal.timeout(WORKER_TIMEOUT_MS),
+      });
+    const bearer = await getAccessToken(token);
+    let res = await get(bearer);
+    if (res.status === 401 && bearer !== token) {
+      // Token di accesso revocato (cambio sede, flag admin) o scaduto: si
+      // ripete col token di sessione, che decide davvero se l'utente e' fuori.
+      forgetAccessToken(token);
+      res = await get(token);
+    }
     if (!res.ok) {
       console.error(`[${context}] worker error:`, res.status);
       return null;
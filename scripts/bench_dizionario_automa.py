@@ -0,0 +1,103 @@
+"""Micro-benchmark: automa Aho-Corasick vs regex lineari del dizionario keyword.
+
+Confronta `_cerca_keyword_dizionario` (automa, percorso caldo di
+`applica_correzioni_dizionario`) con `_cerca_keyword_dizionario_regex`
+(implementazione storica: un re.search per keyword, in ordine di priorita').
+
+Due fasi:
+  1. EQUIVALENZA sul corpus di test: descrizioni reali del golden
+     (tests/fixtures/golden_regole_categoria.json) + tutte le keyword del
+     dizionario, anche minuscole. Un solo output diverso = exit code 1.
+  2. VELOCITA' su N descrizioni (default 100.000) ottenute ricombinando parole
+     del corpus con codici GDO e refusi, cosi' ci sono sia hit sia miss. La fase
+     regex e' lenta per costruzione: con N=100.000 ci mette qualche minuto.
+
+Uso:
+    python scripts/bench_dizionario_automa.py
+    python scripts/bench_dizionario_automa.py --n 20000 --seed 7
+"""
+from __future__ import annotations
+
+import argparse
+import json
+import random
+import sys
+import time
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+try:
+    sys.stdout.reconfigure(encoding='utf-8')  # evita crash su emoji in console Windows
+except Exception:
+    pass
+
+from config.constants import DIZIONARIO_CORREZIONI  # noqa: E402
+from services.ai_service import (  # noqa: E402
+    _cerca_keyword_dizionario,
+    _cerca_keyword_dizionario_regex,
+)
+
+_GOLDEN = ROOT / "tests" / "fixtures" / "golden_regole_categoria.json"
+
+
+def corpus_di_test() -> list[str]:
+    with open(_GOLDEN, encoding="utf-8") as f:
+        golden = json.load(f)
+    descrizioni = sorted({riga[0] for riga in golden})
+    descrizioni += list(DIZIONARIO_CORREZIONI.keys())
+    descrizioni += [k.lower() for k in DIZIONARIO_CORREZIONI.keys()]
+    return descrizioni
+
+
+def corpus_sintetico(base: list[str], n: int, seed: int) -> list[str]:
+    rnd = random.Random(seed)
+    parole = [p for d in base for p in d.split() if p]
+    out = []
+    for _ in range(n):
+        pezzi = rnd.sample(parole, k=min(len(parole), rnd.randint(2, 6)))
+        if rnd.random() < 0.3:
+            pezzi.insert(0, f"{rnd.randint(1, 999)}{pezzi.pop(0)}")   # codice GDO incollato
+        if rnd.random() < 0.2:
+            i = rnd.randrange(len(pezzi))
+            pezzi[i] = "".join(c * 2 if rnd.random() < 0.15 else c for c in pezzi[i])  # refuso doppie
+        out.append(" ".join(pezzi))
+    return out
+
+
+def _cronometra(fn, descrizioni: list[str]) -> tuple[float, list]:
+    t0 = time.perf_counter()
+    risultati = [fn(d) for d in descrizioni]
+    return time.perf_counter() - t0, risultati
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--n", type=int, default=100_000, help="descrizioni sintetiche per la fase velocita'")
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    base = corpus_di_test()
+    base_upper = [d.upper() for d in base]
+    diverse = [d for d in base_upper if _cerca_keyword_dizionario(d) != _cerca_keyword_dizionario_regex(d)]
+    print(f"Equivalenza corpus di test: {len(base_upper)} descrizioni, {len(diverse)} divergenze")
+    for d in diverse[:20]:
+        print(f"  ❌ {d!r}: automa={_cerca_keyword_dizionario(d)} regex={_cerca_keyword_dizionario_regex(d)}")
+    if diverse:
+        return 1
+
+    sintetico = [d.upper() for d in corpus_sintetico(base, args.n, args.seed)]
+    t_automa, r_automa = _cronometra(_cerca_keyword_dizionario, sintetico)
+    t_regex, r_regex = _cronometra(_cerca_keyword_dizionario_regex, sintetico)
+    divergenze = sum(1 for a, b in zip(r_automa, r_regex) if a != b)
+    hit = sum(1 for r in r_automa if r is not None)
+
+    print(f"Corpus sintetico: {len(sintetico)} descrizioni ({hit} con match, {len(sintetico) - hit} senza)")
+    print(f"  automa : {t_automa:8.2f}s  ({t_automa / len(sintetico) * 1e6:7.1f} µs/riga)")
+    print(f"  regex  : {t_regex:8.2f}s  ({t_regex / len(sintetico) * 1e6:7.1f} µs/riga)")
+    print(f"  speedup: {t_regex / t_automa:.1f}x — divergenze: {divergenze}")
+    return 1 if divergenze else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
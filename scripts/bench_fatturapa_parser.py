@@ -0,0 +1,183 @@
+"""Benchmark: parser FatturaPA a eventi vs catena storica decodifica+defusedxml+xmltodict.
+
+Confronta `services.fatturapa_parser.parse_fattura` (un passaggio expat sui
+byte) con il percorso che estrai_dati_da_xml usava prima:
+decodifica_xml_sicuro (cascata encoding + parse defusedxml di sola
+validazione) seguita da xmltodict.parse.
+
+Due fasi:
+  1. EQUIVALENZA: per ogni fattura del corpus sintetico i campi letti da
+     estrai_dati_da_xml (data, numero, tipo, totale, riepiloghi, righe con
+     descrizione/quantita/prezzi/IVA/UM/codice/sconti) devono coincidere con
+     quelli ricavati via safe_get dal dict xmltodict. Un solo scarto = exit 1.
+  2. VELOCITA' e MEMORIA di picco (tracemalloc) per dimensione di fattura:
+     da 5 righe (ristorante tipo) a qualche migliaio (fattura GDO mensile).
+
+Uso:
+    python scripts/bench_fatturapa_parser.py
+    python scripts/bench_fatturapa_parser.py --righe 10 200 5000 --ripetizioni 20
+"""
+from __future__ import annotations
+
+import argparse
+import random
+import sys
+import time
+import tracemalloc
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+try:
+    sys.stdout.reconfigure(encoding='utf-8')  # evita crash su emoji in console Windows
+except Exception:
+    pass
+
+import xmltodict  # noqa: E402
+
+from services.fatturapa_parser import parse_fattura  # noqa: E402
+from services.invoice_service import decodifica_xml_sicuro  # noqa: E402
+from utils.formatters import safe_get  # noqa: E402
+
+_PRODOTTI = ["MOZZARELLA FIOR DI LATTE", "SALMONE AFFUMICATO", "FARINA 00 KG25",
+             "OLIO EVO LT5", "CAFFÈ IN GRANI", "POMODORO PELATO 2,5KG", "RISO CARNAROLI"]
+
+
+def fattura_sintetica(n_righe: int, seed: int, encoding: str = "UTF-8") -> bytes:
+    rnd = random.Random(seed)
+    righe = []
+    for i in range(1, n_righe + 1):
+        q = rnd.randint(1, 40)
+        pu = round(rnd.uniform(0.5, 90), 2)
+        codice = (f"<CodiceArticolo><CodiceTipo>EAN</CodiceTipo><CodiceValore>80{i:011d}</CodiceValore>"
+                  f"</CodiceArticolo><CodiceArticolo><CodiceTipo>INT</CodiceTipo>"
+                  f"<CodiceValore>A{i}</CodiceValore></CodiceArticolo>") if rnd.random() < 0.7 else ""
+        sconto = (f"<ScontoMaggiorazione><Tipo>{rnd.choice(['SC', 'MG'])}</Tipo>"
+                  f"<Percentuale>{rnd.randint(1, 30)}.00</Percentuale></ScontoMaggiorazione>"
+                  if rnd.random() < 0.2 else "")
+        righe.append(
+            f"<DettaglioLinee><NumeroLinea>{i}</NumeroLinea>{codice}"
+            f"<Descrizione>{rnd.choice(_PRODOTTI)} {i}</Descrizione>"
+            f"<Quantita>{q}.00</Quantita><UnitaMisura>{rnd.choice(['KG', 'PZ', 'LT'])}</UnitaMisura>"
+            f"<PrezzoUnitario>{pu:.2f}</PrezzoUnitario>{sconto}"
+            f"<PrezzoTotale>{q * pu:.2f}</PrezzoTotale><AliquotaIVA>{rnd.choice(['4.00', '10.00', '22.00'])}"
+            f"</AliquotaIVA></DettaglioLinee>"
+        )
+    xml = (
+        f'<?xml version="1.0" encoding="{encoding}"?>'
+        '<p:FatturaElettronica xmlns:p="http://ivaservizi.agenziaentrate.gov.it/docs/xsd/fatture/v1.2" '
+        'versione="FPR12"><FatturaElettronicaHeader><CedentePrestatore><DatiAnagrafici><IdFiscaleIVA>'
+        '<IdPaese>IT</IdPaese><IdCodice>01234567890</IdCodice></IdFiscaleIVA><Anagrafica>'
+        '<Denominazione>GROSSISTA SPA</Denominazione></Anagrafica></DatiAnagrafici></CedentePrestatore>'
+        '<CessionarioCommittente><DatiAnagrafici><IdFiscaleIVA><IdPaese>IT</IdPaese>'
+        '<IdCodice>09876543210</IdCodice></IdFiscaleIVA></DatiAnagrafici></CessionarioCommittente>'
+        '</FatturaElettronicaHeader><FatturaElettronicaBody><DatiGenerali><DatiGeneraliDocumento>'
+        f'<TipoDocumento>TD01</TipoDocumento><Data>2026-03-{seed % 28 + 1:02d}</Data>'
+        f'<Numero>{seed}/A</Numero><ImportoTotaleDocumento>1234.56</ImportoTotaleDocumento>'
+        '</DatiGeneraliDocumento></DatiGenerali><DatiBeniServizi>' + "".join(righe) +
+        '<DatiRiepilogo><AliquotaIVA>10.00</AliquotaIVA><ImponibileImporto>1000.00</ImponibileImporto>'
+        '<Imposta>100.00</Imposta></DatiRiepilogo><DatiRiepilogo><AliquotaIVA>22.00</AliquotaIVA>'
+        '<ImponibileImporto>100.00</ImponibileImporto><Imposta>22.00</Imposta></DatiRiepilogo>'
+        '</DatiBeniServizi><DatiPagamento><DettaglioPagamento><DataScadenzaPagamento>2026-04-30'
+        '</DataScadenzaPagamento></DettaglioPagamento></DatiPagamento></FatturaElettronicaBody>'
+        '</p:FatturaElettronica>'
+    )
+    return xml.encode("cp1252" if encoding.lower() == "windows-1252" else "utf-8")
+
+
+# ── Percorso storico ─────────────────────────────────────────────────────────
+
+def _come_lista(v) -> list:
+    return v if isinstance(v, list) else ([v] if v is not None else [])
+
+
+def campi_storici(contenuto: bytes) -> dict:
+    doc = xmltodict.parse(decodifica_xml_sicuro(contenuto))
+    fattura = doc[next(iter(doc))]
+    dgd = ['FatturaElettronicaBody', 'DatiGenerali', 'DatiGeneraliDocumento']
+    body = safe_get(fattura, ['FatturaElettronicaBody'], default={}, keep_list=False)
+    linee = _come_lista(safe_get(body, ['DatiBeniServizi', 'DettaglioLinee'], default=[], keep_list=True))
+    righe = []
+    for r in linee:
+        codici = _come_lista(r.get('CodiceArticolo'))
+        righe.append((
+            r.get('NumeroLinea'), r.get('Descrizione'), r.get('Quantita'), r.get('UnitaMisura'),
+            r.get('PrezzoUnitario'), r.get('PrezzoTotale'), r.get('AliquotaIVA'),
+            codici[0].get('CodiceValore', '') if codici else '',
+            [(s.get('Tipo', 'SC'), s.get('Percentuale')) for s in _come_lista(r.get('ScontoMaggiorazione'))],
+        ))
+    riepiloghi = _come_lista(safe_get(fattura, ['FatturaElettronicaBody', 'DatiBeniServizi', 'DatiRiepilogo'],
+                                      default=[], keep_list=True))
+    return {
+        'data': safe_get(fattura, dgd + ['Data'], default=None, keep_list=False),
+        'numero': safe_get(fattura, dgd + ['Numero'], default=None, keep_list=False),
+        'tipo': safe_get(fattura, dgd + ['TipoDocumento'], default=None, keep_list=False),
+        'totale': safe_get(fattura, dgd + ['ImportoTotaleDocumento'], default=None, keep_list=False),
+        'riepiloghi': [(x.get('ImponibileImporto'), x.get('Imposta')) for x in riepiloghi],
+        'cedente': safe_get(fattura, ['FatturaElettronicaHeader', 'CedentePrestatore', 'DatiAnagrafici',
+                                      'IdFiscaleIVA', 'IdCodice'], default=None, keep_list=False),
+        'righe': righe,
+    }
+
+
+def campi_nuovi(contenuto: bytes) -> dict:
+    fpa = parse_fattura(contenuto, solo_primo_corpo=True)
+    c = fpa.corpi[0]
+    return {
+        'data': c.data, 'numero': c.numero, 'tipo': c.tipo_documento, 'totale': c.importo_totale,
+        'riepiloghi': [tuple(x) for x in c.riepiloghi],
+        'cedente': safe_get(fpa.testata, ['FatturaElettronicaHeader', 'CedentePrestatore', 'DatiAnagrafici',
+                                          'IdFiscaleIVA', 'IdCodice'], default=None, keep_list=False),
+        'righe': [(r.numero_linea, r.descrizione, r.quantita, r.unita_misura, r.prezzo_unitario,
+                   r.prezzo_totale, r.aliquota_iva, r.codice_articolo, [tuple(s) for s in r.sconti])
+                  for r in c.righe()],
+    }
+
+
+def _misura(fn, contenuto: bytes, ripetizioni: int) -> tuple[float, int]:
+    t0 = time.perf_counter()
+    for _ in range(ripetizioni):
+        fn(contenuto)
+    durata = (time.perf_counter() - t0) / ripetizioni
+    tracemalloc.start()
+    fn(contenuto)
+    _, picco = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return durata, picco
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--righe", type=int, nargs="+", default=[5, 50, 500, 5000])
+    parser.add_argument("--ripetizioni", type=int, default=10)
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    # 1. Equivalenza
+    scarti = 0
+    for i in range(200):
+        enc = "windows-1252" if i % 5 == 0 else "UTF-8"
+        contenuto = fattura_sintetica(random.Random(args.seed + i).randint(1, 60), args.seed + i, enc)
+        vecchio, nuovo = campi_storici(contenuto), campi_nuovi(contenuto)
+        if vecchio != nuovo:
+            scarti += 1
+            if scarti <= 3:
+                print(f"❌ fattura {i}: {vecchio} != {nuovo}")
+    print(f"Equivalenza: {200 - scarti}/200 fatture identiche")
+    if scarti:
+        return 1
+
+    # 2. Velocita' e memoria
+    print(f"{'righe':>6} {'KB':>7} | {'storico ms':>10} {'MB':>6} | {'expat ms':>9} {'MB':>6} | {'x':>5}")
+    for n in args.righe:
+        contenuto = fattura_sintetica(n, args.seed)
+        rip = max(1, args.ripetizioni if n <= 500 else args.ripetizioni // 5)
+        t_old, m_old = _misura(campi_storici, contenuto, rip)
+        t_new, m_new = _misura(campi_nuovi, contenuto, rip)
+        print(f"{n:>6} {len(contenuto) / 1024:>7.0f} | {t_old * 1000:>10.1f} {m_old / 2**20:>6.1f} | "
+              f"{t_new * 1000:>9.1f} {m_new / 2**20:>6.1f} | {t_old / t_new:>5.1f}")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
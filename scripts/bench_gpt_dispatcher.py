@@ -0,0 +1,160 @@
+"""Benchmark: classifica_con_ai seriale vs dispatcher concorrente, contro un finto server OpenAI.
+
+Avvia in locale un server HTTP compatibile con /v1/chat/completions che:
+  - risponde dopo `--latenza` secondi con una categoria per ogni idx del payload;
+  - restituisce 429 (Retry-After: 1) se ha gia' piu' di `--max-in-volo`
+    richieste in corso, come il limite di concorrenza/TPM di OpenAI.
+Il client e' la libreria `openai` vera puntata su quel server (max_retries=0:
+i 429 li gestiscono tenacity + il backoff condiviso di services/gpt_dispatcher).
+
+Misura il tempo per classificare N descrizioni con ONEFLUX_AI_CONCORRENZA=1
+(comportamento storico, un batch dopo l'altro) e con la concorrenza richiesta,
+e verifica che gli esiti coincidano. Nessuna chiamata a OpenAI reale, nessun
+accesso a Supabase (cache risposte spenta).
+
+Uso:
+    python scripts/bench_gpt_dispatcher.py
+    python scripts/bench_gpt_dispatcher.py --descrizioni 600 --latenza 0.8 --concorrenza 6 --max-in-volo 3
+"""
+from __future__ import annotations
+
+import argparse
+import json
+import logging
+import os
+import re
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+try:
+    sys.stdout.reconfigure(encoding='utf-8')  # evita crash su emoji in console Windows
+except Exception:
+    pass
+
+os.environ["ONEFLUX_AI_CACHE_TTL_GIORNI"] = "0"
+
+from services._streamlit_shim import install as _installa_shim  # noqa: E402
+
+_installa_shim()
+
+from openai import OpenAI  # noqa: E402
+
+from services import gpt_dispatcher  # noqa: E402
+from services.ai_service import classifica_con_ai  # noqa: E402
+
+# Solo gli articoli del payload (il template del prompt contiene esempi con "idx").
+_RE_IDX = re.compile(r'\{"idx":\s*(\d+),\s*"articolo"')
+
+
+class _Stato:
+    def __init__(self, latenza: float, max_in_volo: int):
+        self.latenza = latenza
+        self.max_in_volo = max_in_volo
+        self.in_volo = 0
+        self.richieste = 0
+        self.rifiutate = 0
+        self.lock = threading.Lock()
+
+
+def _handler(stato: _Stato):
+    class FintoOpenAI(BaseHTTPRequestHandler):
+        def log_message(self, *_a):
+            pass
+
+        def _rispondi(self, codice: int, corpo: dict, headers: dict | None = None):
+            dati = json.dumps(corpo).encode()
+            self.send_response(codice)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(dati)))
+            for k, v in (headers or {}).items():
+                self.send_header(k, v)
+            self.end_headers()
+            self.wfile.write(dati)
+
+        def do_POST(self):
+            corpo = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+            with stato.lock:
+                stato.richieste += 1
+                if stato.in_volo >= stato.max_in_volo:
+                    stato.rifiutate += 1
+                    rifiuta = True
+                else:
+                    stato.in_volo += 1
+                    rifiuta = False
+            if rifiuta:
+                self._rispondi(429, {"error": {"message": "Rate limit", "type": "requests"}},
+                               {"retry-after": "1"})
+                return
+            try:
+                time.sleep(stato.latenza)
+                idx = [int(i) for i in _RE_IDX.findall(corpo["messages"][0]["content"])]
+                risultati = [{"idx": i, "categoria": "CARNE", "confidence": "alta"} for i in idx]
+                self._rispondi(200, {
+                    "id": "chatcmpl-finto", "object": "chat.completion", "created": int(time.time()),
+                    "model": corpo.get("model", "finto"),
+                    "choices": [{"index": 0, "finish_reason": "stop",
+                                 "message": {"role": "assistant",
+                                             "content": json.dumps({"risultati": risultati})}}],
+                    "usage": {"prompt_tokens": 6000, "completion_tokens": 30 * len(idx),
+                              "total_tokens": 6000 + 30 * len(idx)},
+                })
+            finally:
+                with stato.lock:
+                    stato.in_volo -= 1
+
+    return FintoOpenAI
+
+
+def _misura(descrizioni, client, concorrenza: int):
+    os.environ["ONEFLUX_AI_CONCORRENZA"] = str(concorrenza)
+    gpt_dispatcher.reset()
+    t0 = time.perf_counter()
+    categorie = classifica_con_ai(descrizioni, openai_client=client)
+    return time.perf_counter() - t0, categorie
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--descrizioni", type=int, default=600)
+    parser.add_argument("--latenza", type=float, default=0.5, help="secondi per risposta del finto server")
+    parser.add_argument("--concorrenza", type=int, default=4)
+    parser.add_argument("--max-in-volo", type=int, default=4, help="oltre questa soglia il server risponde 429")
+    parser.add_argument("--batch-max", type=int, default=30)
+    args = parser.parse_args()
+
+    logging.disable(logging.WARNING)
+    os.environ["ONEFLUX_AI_BATCH_MAX"] = str(args.batch_max)
+    stato = _Stato(args.latenza, args.max_in_volo)
+    server = ThreadingHTTPServer(("127.0.0.1", 0), _handler(stato))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    client = OpenAI(api_key="finta", base_url=f"http://127.0.0.1:{server.server_port}/v1", max_retries=0)
+
+    descrizioni = [f"PETTO DI POLLO KG{i % 7 + 1} LOTTO {i}" for i in range(args.descrizioni)]
+    try:
+        t_seriale, cat_seriale = _misura(descrizioni, client, 1)
+        richieste_seriale = stato.richieste
+        stato.richieste = stato.rifiutate = 0
+        t_conc, cat_conc = _misura(descrizioni, client, args.concorrenza)
+    finally:
+        server.shutdown()
+        gpt_dispatcher.reset()
+
+    print(f"{args.descrizioni} descrizioni, batch max {args.batch_max}, latenza {args.latenza}s")
+    print(f"  seriale     : {t_seriale:6.2f}s  richieste={richieste_seriale}")
+    print(f"  concorrenza {args.concorrenza}: {t_conc:6.2f}s  richieste={stato.richieste} "
+          f"(429={stato.rifiutate})  x{t_seriale / t_conc:.1f}")
+    if cat_seriale != cat_conc:
+        print("❌ esiti diversi fra seriale e concorrente")
+        return 1
+    da_classificare = sum(1 for c in cat_conc if c == "Da Classificare")
+    print(f"  esiti identici, Da Classificare: {da_classificare}")
+    return 0 if not da_classificare else 1
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+"""Rebuild e verifica di coerenza del cubo dei costi mensili (public.costi_mensili_cubo).
+
+La tabella la mantengono i trigger su fatture e sulle quote di riparto; questo
+script serve dopo un ripristino del DB, una modifica delle regole del cubo
+nella migration, o per controllare che celle e righe grezze dicano la stessa cosa.
+
+Uso:
+  python scripts/costi_cubo.py --verifica --ristorante-id <uuid>
+  python scripts/costi_cubo.py --ricostruisci --ristorante-id <uuid>
+  python scripts/costi_cubo.py --ricostruisci            # tutte le sedi
+  python scripts/costi_cubo.py --ricostruisci --verifica --ristorante-id <uuid>
+"""
+
+from __future__ import annotations
+
+import argparse
+import json
+import os
+import sys
+from pathlib import Path
+
+try:
+    import tomllib
+except ImportError:
+    import tomli as tomllib  # type: ignore
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+
+def _bootstrap_supabase_env_from_secrets() -> None:
+    secrets_path = ROOT / ".streamlit" / "secrets.toml"
+    if not secrets_path.exists():
+        return
+    try:
+        with secrets_path.open("rb") as f:
+            secrets = tomllib.load(f)
+    except Exception:
+        return
+    cfg = secrets.get("supabase", {})
+    if cfg.get("url"):
+        os.environ["SUPABASE_URL"] = cfg["url"]
+    if cfg.get("service_role_key"):
+        os.environ["SUPABASE_SERVICE_ROLE_KEY"] = cfg["service_role_key"]
+    if cfg.get("key"):
+        os.environ.setdefault("SUPABASE_KEY", cfg["key"])
+
+
+_bootstrap_supabase_env_from_secrets()
+
+from services import costi_cubo, get_supabase_client  # noqa: E402
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--ristorante-id", help="sede da trattare (rebuild: omesso = tutte)")
+    parser.add_argument("--ricostruisci", action="store_true", help="ricalcola la tabella da zero")
+    parser.add_argument("--verifica", action="store_true", help="confronta le celle con le righe grezze")
+    args = parser.parse_args()
+
+    if not (args.ricostruisci or args.verifica):
+        parser.error("serve --ricostruisci e/o --verifica")
+    if args.verifica and not args.ristorante_id:
+        parser.error("--verifica richiede --ristorante-id")
+
+    sb = get_supabase_client()
+    if args.ricostruisci:
+        n = costi_cubo.ricostruisci(args.ristorante_id, sb)
+        print(f"Ricostruite {n} celle")
+    if args.verifica:
+        esito = costi_cubo.verifica_coerenza(args.ristorante_id, sb)
+        print(json.dumps(esito, indent=2, ensure_ascii=False))
+        return 0 if esito["coerente"] else 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
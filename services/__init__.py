@@ -22,6 +22,7 @@ from .ai_service import (
     invalida_cache_memoria,
     ottieni_categoria_prodotto,
     categorizza_con_memoria,
+    categorizza_batch,
     flush_pending_local_saves,
     applica_correzioni_dizionario,
     salva_correzione_in_memoria_globale,
@@ -54,6 +55,7 @@ __all__ = [
     'invalida_cache_memoria',
     'ottieni_categoria_prodotto',
     'categorizza_con_memoria',
+    'categorizza_batch',
     'applica_correzioni_dizionario',
     'salva_correzione_in_memoria_globale',
     'salva_correzione_in_memoria_locale',
@@ -0,0 +1,447 @@
+"""Classificazione AI in blocco per il lavoro notturno: job JSONL, poll, applicazione in bulk.
+
+Problema: l'agent notturno mandava il backlog 'da_verificare' (centinaia di
+descrizioni) a GPT con la stessa chat-completion sincrona degli upload, batch
+da 40 uno dopo l'altro. Consumava lo stesso limite RPM/TPM degli upload del
+mattino presto e, se il worker ripartiva a meta', ricominciava da zero
+pagando di nuovo i batch gia' fatti.
+
+Qui il backlog diventa un job:
+
+1. `prepara_righe`: i batch (services/gpt_dispatcher.dimensiona_batch) sono
+   serializzati come righe JSONL nel formato Batch API di OpenAI
+   ({custom_id, method, url, body}) con lo stesso prompt/payload di
+   ai_service._chiama_gpt_classificazione.
+2. Il job e' salvato in `ai_batch_job` (checkpoint) PRIMA dell'invio.
+3. Un runner lo esegue:
+   - `RunnerOpenAI`: upload del file + /v1/batches (finestra 24h). Il Batch
+     API ha limiti separati da quelli delle chiamate sincrone e costa la
+     meta': la notte non sottrae nulla agli upload.
+   - `RunnerLocale` (default, sostituto in-process): esegue le righe una alla
+     volta con un secchio proprio pari a ONEFLUX_AI_BATCH_QUOTA_PCT (default
+     25%) dei limiti, oltre al secchio condiviso: non satura mai la quota
+     che serve agli upload.
+4. Poll fino a completamento (ONEFLUX_AI_BATCH_ATTESA_MAX_S). Se il batch
+   remoto non e' pronto il job resta 'inviato' e il giro dopo lo riprende.
+5. I risultati si applicano a blocchi con UNA chiamata RPC
+   (`applica_suggerimenti_ai_bulk`) per blocco; dopo ogni blocco il
+   checkpoint registra i custom_id applicati. Un riavvio riprende dal primo
+   non applicato, senza ripagare ne' riscrivere cio' che e' gia' fatto.
+
+Come in prepara_suggerimenti_ai, si scrivono solo SUGGERIMENTI
+(prodotti_master.categoria_suggerita), mai fatture.categoria.
+"""
+
+from __future__ import annotations
+
+import io
+import json
+import os
+import time
+import uuid
+from datetime import datetime, timezone
+from typing import Any, Callable, Dict, Iterator, List, Optional, Sequence, Set, Tuple
+
+from config.logger_setup import get_logger
+
+logger = get_logger('ai_batch_notturno')
+
+_TABELLA = "ai_batch_job"
+_RPC_APPLICA = "applica_suggerimenti_ai_bulk"
+_URL_CHAT = "/v1/chat/completions"
+# Voci per chiamata RPC: un payload jsonb di ~500 descrizioni resta piccolo e
+# un checkpoint ogni 500 limita il lavoro rifatto dopo un riavvio.
+_BLOCCO_APPLICA = 500
+_ATTESA_MAX_S_DEFAULT = 600
+# Un job aperto dall'ALTRO runner non si puo' interrogare da qui: senza una
+# scadenza resterebbe 'inviato' per sempre e bloccherebbe ogni giro successivo.
+# Oltre la finestra del Batch API (24h) con margine lo si chiude come fallito.
+_SCADENZA_ALTRO_RUNNER_ORE_DEFAULT = 48
+_POLL_S = 15.0
+
+STATI_APERTI = ("preparato", "inviato")
+
+
+def _env_int(nome: str, default: int) -> int:
+    try:
+        return int(os.getenv(nome, default))
+    except (TypeError, ValueError):
+        return default
+
+
+def modalita_notturna() -> str:
+    """'batch' (default) o 'sincrona' (vecchio percorso classifica_con_ai)."""
+    valore = (os.getenv("ONEFLUX_AI_NOTTURNO_MODALITA") or "batch").strip().lower()
+    return valore if valore in ("batch", "sincrona") else "batch"
+
+
+def _adesso() -> str:
+    return datetime.now(timezone.utc).isoformat()
+
+
+# ============================================================
+# RIGHE JSONL
+# ============================================================
+
+def prepara_righe(
+    job_id: str,
+    descrizioni: Sequence[str],
+    fornitori: Sequence[str],
+    max_tokens: int = 4096,
+) -> Tuple[List[Dict[str, Any]], List[Dict[str, Any]]]:
+    """Righe JSONL (formato Batch API) + richieste da salvare nel checkpoint.
+
+    Ogni richiesta ricorda le descrizioni ORIGINALI del suo batch: la risposta
+    mappa per idx, e il suggerimento va scritto sulla descrizione di fatture,
+    non su quella normalizzata inviata a GPT.
+    """
+    from services.ai_service import _componi_prompt_classificazione, _richiesta_classificazione
+    from services.gpt_dispatcher import dimensiona_batch
+
+    forn_per_desc = dict(zip(descrizioni, fornitori))
+    righe: List[Dict[str, Any]] = []
+    richieste: List[Dict[str, Any]] = []
+    for n, batch in enumerate(dimensiona_batch(list(descrizioni), max_token_risposta=max_tokens)):
+        batch_forn = [forn_per_desc.get(d, "") for d in batch]
+        prompt, _norm, _hint = _componi_prompt_classificazione(batch, batch_forn)
+        custom_id = f"{job_id}:{n}"
+        righe.append({
+            "custom_id": custom_id,
+            "method": "POST",
+            "url": _URL_CHAT,
+            "body": _richiesta_classificazione(prompt, max_tokens),
+        })
+        richieste.append({"custom_id": custom_id, "descrizioni": batch, "fornitori": batch_forn})
+    return righe, richieste
+
+
+def righe_da_richieste(richieste: Sequence[Dict[str, Any]], max_tokens: int = 4096) -> List[Dict[str, Any]]:
+    """Ricostruisce le righe JSONL dal checkpoint (ripresa col runner locale)."""
+    from services.ai_service import _componi_prompt_classificazione, _richiesta_classificazione
+
+    righe = []
+    for r in richieste:
+        prompt, _norm, _hint = _componi_prompt_classificazione(list(r["descrizioni"]), list(r["fornitori"]))
+        righe.append({
+            "custom_id": r["custom_id"], "method": "POST", "url": _URL_CHAT,
+            "body": _richiesta_classificazione(prompt, max_tokens),
+        })
+    return righe
+
+
+def contenuto_risposta(riga_output: Dict[str, Any]) -> Optional[str]:
+    """Testo della chat-completion da una riga di output del Batch API (None se errore)."""
+    risposta = riga_output.get("response") or {}
+    if riga_output.get("error") or int(risposta.get("status_code") or 0) != 200:
+        return None
+    try:
+        return risposta["body"]["choices"][0]["message"]["content"]
+    except (KeyError, IndexError, TypeError):
+        return None
+
+
+def _usage(riga_output: Dict[str, Any]) -> Tuple[int, int]:
+    usage = ((riga_output.get("response") or {}).get("body") or {}).get("usage") or {}
+    return int(usage.get("prompt_tokens") or 0), int(usage.get("completion_tokens") or 0)
+
+
+# ============================================================
+# RUNNER
+# ============================================================
+
+class RunnerOpenAI:
+    """Batch API di OpenAI: file JSONL + /v1/batches, risultati dal file di output."""
+
+    nome = "openai"
+
+    def __init__(self, client):
+        self.client = client
+
+    def invia(self, job_id: str, righe: List[Dict[str, Any]]) -> str:
+        dati = "\n".join(json.dumps(r, ensure_ascii=False) for r in righe).encode("utf-8")
+        file_in = self.client.files.create(file=(f"{job_id}.jsonl", io.BytesIO(dati)), purpose="batch")
+        batch = self.client.batches.create(
+            input_file_id=file_in.id, endpoint=_URL_CHAT, completion_window="24h",
+            metadata={"job": job_id},
+        )
+        return batch.id
+
+    def stato(self, id_remoto: str) -> str:
+        """'in_corso' | 'completato' | 'fallito'."""
+        batch = self.client.batches.retrieve(id_remoto)
+        if batch.status == "completed":
+            return "completato"
+        if batch.status in ("failed", "expired", "cancelled"):
+            return "fallito"
+        return "in_corso"
+
+    def risultati(self, id_remoto: str, righe: List[Dict[str, Any]], salta: Set[str]) -> Iterator[Dict[str, Any]]:
+        batch = self.client.batches.retrieve(id_remoto)
+        if not batch.output_file_id:
+            return
+        testo = self.client.files.content(batch.output_file_id).text
+        for linea in testo.splitlines():
+            if not linea.strip():
+                continue
+            riga = json.loads(linea)
+            if riga.get("custom_id") not in salta:
+                yield riga
+
+
+class RunnerLocale:
+    """Sostituto in-process del Batch API: stesse righe, eseguite in coda a bassa priorita'.
+
+    Nessuno stato remoto: `invia` non fa nulla e `risultati` esegue le righe
+    non ancora applicate, una alla volta, producendo righe nel formato di
+    output del Batch API. Dopo un riavvio si riparte dal checkpoint.
+    """
+
+    nome = "locale"
+
+    def __init__(self, client, quota_pct: Optional[int] = None,
+                 dormi: Callable[[float], None] = time.sleep):
+        from services import gpt_dispatcher
+
+        self.client = client
+        pct = quota_pct if quota_pct is not None else _env_int("ONEFLUX_AI_BATCH_QUOTA_PCT", 25)
+        pct = min(100, max(1, pct))
+        condiviso = gpt_dispatcher.bucket()
+        self._secchio = gpt_dispatcher.TokenBucket(
+            rpm=max(1, condiviso.rpm * pct // 100),
+            tpm=max(1, condiviso.tpm * pct // 100),
+            dormi=dormi,
+        )
+
+    def invia(self, job_id: str, righe: List[Dict[str, Any]]) -> str:
+        return f"locale:{job_id}"
+
+    def stato(self, id_remoto: str) -> str:
+        return "completato"
+
+    def risultati(self, id_remoto: str, righe: List[Dict[str, Any]], salta: Set[str]) -> Iterator[Dict[str, Any]]:
+        from services import gpt_dispatcher
+
+        for riga in righe:
+            if riga["custom_id"] in salta:
+                continue
+            body = riga["body"]
+            token = gpt_dispatcher.stima_token(body["messages"][0]["content"]) + int(body.get("max_tokens") or 0)
+            self._secchio.acquisisci(token)
+            gpt_dispatcher.attendi_slot(token)
+            try:
+                resp = self.client.chat.completions.create(**body)
+            except Exception as exc:
+                if gpt_dispatcher.e_rate_limit(exc):
+                    gpt_dispatcher.segnala_429(exc)
+                logger.warning("batch locale %s: %s", riga["custom_id"], exc)
+                yield {"custom_id": riga["custom_id"], "response": None, "error": {"message": str(exc)[:200]}}
+                continue
+            gpt_dispatcher.segnala_successo()
+            usage = getattr(resp, "usage", None)
+            yield {
+                "custom_id": riga["custom_id"],
+                "response": {"status_code": 200, "body": {
+                    "choices": [{"message": {"content": resp.choices[0].message.content}}],
+                    "usage": {
+                        "prompt_tokens": getattr(usage, "prompt_tokens", 0) or 0,
+                        "completion_tokens": getattr(usage, "completion_tokens", 0) or 0,
+                    },
+                }},
+                "error": None,
+            }
+
+
+def runner_default(client=None):
+    """ONEFLUX_AI_BATCH_RUNNER=openai usa il Batch API, altrimenti il runner locale."""
+    if client is None:
+        from services.ai_service import _get_openai_client
+
+        client = _get_openai_client()
+    if (os.getenv("ONEFLUX_AI_BATCH_RUNNER") or "").strip().lower() == "openai":
+        return RunnerOpenAI(client)
+    return RunnerLocale(client)
+
+
+# ============================================================
+# CHECKPOINT
+# ============================================================
+
+def _job_aperto(sb) -> Optional[Dict[str, Any]]:
+    try:
+        resp = (
+            sb.table(_TABELLA)
+            .select("*")
+            .in_("stato", list(STATI_APERTI))
+            .order("created_at", desc=True)
+            .limit(1)
+            .execute()
+        )
+    except Exception as exc:
+        logger.warning("batch notturno: lettura checkpoint fallita: %s", exc)
+        return None
+    rows = resp.data
+    return rows[0] if isinstance(rows, list) and rows else None
+
+
+def _scaduto(job: Dict[str, Any], ore: int) -> bool:
+    """True se il job non avanza da piu' di `ore` (updated_at, o created_at)."""
+    ts = job.get("updated_at") or job.get("created_at")
+    if not ts:
+        return True
+    try:
+        quando = datetime.fromisoformat(str(ts).replace("Z", "+00:00"))
+    except ValueError:
+        return True
+    if quando.tzinfo is None:
+        quando = quando.replace(tzinfo=timezone.utc)
+    return (datetime.now(timezone.utc) - quando).total_seconds() > ore * 3600
+
+
+def _aggiorna(sb, job_id: str, **campi) -> None:
+    sb.table(_TABELLA).update({**campi, "updated_at": _adesso()}).eq("id", job_id).execute()
+
+
+def _applica_blocco(sb, voci: List[Dict[str, str]]) -> int:
+    resp = sb.rpc(_RPC_APPLICA, {"p_voci": voci}).execute()
+    return int(resp.data) if isinstance(resp.data, int) else len(voci)
+
+
+# ============================================================
+# ORCHESTRAZIONE
+# ============================================================
+
+def esegui_job(
+    sb,
+    descrizioni: Sequence[str],
+    fornitori: Sequence[str],
+    runner=None,
+    attore: str = "agent-notturno",
+    attesa_max_s: Optional[float] = None,
+    dormi: Callable[[float], None] = time.sleep,
+) -> Dict[str, Any]:
+    """Classifica `descrizioni` come job batch e applica i suggerimenti in bulk.
+
+    Se esiste un job aperto (riavvio a meta' giro, batch remoto non ancora
+    pronto) riprende quello e ignora le descrizioni passate: saranno
+    ricalcolate al giro successivo, gia' al netto di quanto applicato.
+    Ritorna i contatori di prepara_suggerimenti_ai + job/stato.
+    """
+    from config.constants import TUTTE_LE_CATEGORIE
+    from services.ai_service import (
+        _esiti_classificazione, _mappa_categorie_ai_per_idx, _rifinisci_categoria_ai,
+    )
+
+    esito: Dict[str, Any] = {"suggerite": 0, "saltate": 0, "errori": 0, "job": None, "stato": None}
+    runner = runner or runner_default()
+    attesa_max_s = _env_int("ONEFLUX_AI_BATCH_ATTESA_MAX_S", _ATTESA_MAX_S_DEFAULT) if attesa_max_s is None else attesa_max_s
+
+    job = _job_aperto(sb)
+    if job is not None and job.get("runner") and job["runner"] != runner.nome:
+        ore = _env_int("ONEFLUX_AI_BATCH_SCADENZA_ORE", _SCADENZA_ALTRO_RUNNER_ORE_DEFAULT)
+        if _scaduto(job, ore):
+            logger.warning("batch notturno: job %s del runner %s fermo da oltre %dh, chiuso come fallito",
+                           job["id"], job["runner"], ore)
+            _aggiorna(sb, job["id"], stato="fallito", errore=f"scaduto: runner {job['runner']} non raggiungibile")
+            job = None
+    if job is None:
+        if not descrizioni:
+            return esito
+        job_id = f"notturno-{datetime.now(timezone.utc):%Y%m%d%H%M%S}-{uuid.uuid4().hex[:6]}"
+        righe, richieste = prepara_righe(job_id, descrizioni, fornitori)
+        job = {
+            "id": job_id, "stato": "preparato", "runner": runner.nome, "attore": attore,
+            "richieste": richieste, "applicati": [], "id_remoto": None,
+            "created_at": _adesso(), "updated_at": _adesso(),
+        }
+        sb.table(_TABELLA).insert(job).execute()
+    else:
+        righe = righe_da_richieste(job.get("richieste") or [])
+        logger.info("batch notturno: riprendo job %s (stato=%s, applicati=%d/%d)",
+                    job["id"], job["stato"], len(job.get("applicati") or []), len(righe))
+    job_id = job["id"]
+    esito["job"] = job_id
+
+    if job.get("runner") and job["runner"] != runner.nome:
+        # Job remoto avviato con l'altro runner: non lo si puo' interrogare da qui.
+        logger.warning("batch notturno: job %s e' del runner %s, non %s", job_id, job["runner"], runner.nome)
+        esito["stato"] = job["stato"]
+        return esito
+
+    if job["stato"] == "preparato":
+        id_remoto = runner.invia(job_id, righe)
+        _aggiorna(sb, job_id, stato="inviato", id_remoto=id_remoto)
+        job["id_remoto"] = id_remoto
+
+    t0 = time.monotonic()
+    while True:
+        stato_remoto = runner.stato(job["id_remoto"])
+        if stato_remoto != "in_corso":
+            break
+        if time.monotonic() - t0 >= attesa_max_s:
+            logger.info("batch notturno: job %s ancora in corso, ripreso al prossimo giro", job_id)
+            esito["stato"] = "inviato"
+            return esito
+        dormi(_POLL_S)
+
+    if stato_remoto == "fallito":
+        _aggiorna(sb, job_id, stato="fallito", errore="batch remoto fallito/scaduto")
+        esito["stato"] = "fallito"
+        esito["errori"] = sum(len(r["descrizioni"]) for r in job.get("richieste") or [])
+        return esito
+
+    categorie_valide = set(TUTTE_LE_CATEGORIE) | {"📝 NOTE E DICITURE"}
+    richieste = {r["custom_id"]: r for r in job.get("richieste") or []}
+    applicati: List[str] = list(job.get("applicati") or [])
+    adesso = _adesso()
+    voci: List[Dict[str, str]] = []
+    in_blocco: List[str] = []
+    token_prompt = token_risposta = 0
+
+    def _scarica_blocco() -> None:
+        nonlocal voci, in_blocco
+        if voci:
+            esito["suggerite"] += _applica_blocco(sb, voci)
+        applicati.extend(in_blocco)
+        _aggiorna(sb, job_id, applicati=applicati)
+        voci, in_blocco = [], []
+
+    for riga in runner.risultati(job["id_remoto"], righe, set(applicati)):
+        richiesta = richieste.get(riga.get("custom_id"))
+        if richiesta is None:
+            continue
+        descs = list(richiesta["descrizioni"])
+        p, c = _usage(riga)
+        token_prompt += p
+        token_risposta += c
+        testo = contenuto_risposta(riga)
+        try:
+            dati = json.loads(testo) if testo else None
+        except ValueError:
+            dati = None
+        if not isinstance(dati, dict):
+            esito["errori"] += len(descs)
+        else:
+            categorie, confidenze, _mem = _esiti_classificazione(*_mappa_categorie_ai_per_idx(dati), descs)
+            fornitori_req = list(richiesta.get("fornitori") or [])
+            for i, (desc, cat, conf) in enumerate(zip(descs, categorie, confidenze)):
+                # Safety net e regole forti come nel percorso sincrono: senza, una
+                # risposta GPT sbagliata "con sicurezza" diventava suggerimento.
+                forn = fornitori_req[i] if i < len(fornitori_req) else None
+                cat, _conf, _tipo = _rifinisci_categoria_ai(desc, cat, conf, forn)
+                cat = (cat or "").strip()
+                # Stessi scarti di prepara_suggerimenti_ai: niente fallback o categorie inventate.
+                if cat and cat not in ("Da Classificare", "Da Clasificare") and cat in categorie_valide:
+                    voci.append({"descrizione": desc, "categoria_suggerita": cat, "suggerito_at": adesso})
+        in_blocco.append(richiesta["custom_id"])
+        if len(voci) >= _BLOCCO_APPLICA:
+            _scarica_blocco()
+    _scarica_blocco()
+
+    _aggiorna(sb, job_id, stato="applicato")
+    esito["stato"] = "applicato"
+    logger.info(
+        "batch notturno: job %s applicato (runner=%s) suggerite=%d errori=%d token=%d+%d "
+        "(fuori dal ledger ai_usage_events: nessun ristorante_id, tool globale) | attore=%s",
+        job_id, runner.nome, esito["suggerite"], esito["errori"], token_prompt, token_risposta, attore,
+    )
+    return esito
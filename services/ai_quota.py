@@ -0,0 +1,234 @@
+"""Quote AI giornaliere per ristorante con contatori in memoria e prenotazione atomica.
+
+Problema: ogni classifica_con_ai (e ogni upload Vision) faceva prima un
+COUNT(*) esatto su ai_usage_events per ristorante e giorno: un round-trip e
+una scansione d'indice che cresce con l'uso della giornata, prima di OGNI
+batch AI. E il controllo era "usati < limite" letto e poi agito: due upload
+concorrenti con 999/1000 passavano entrambi e sforavano
+MAX_AI_CALLS_PER_DAY / VISION_DAILY_LIMIT di quante chiamate facevano.
+
+Qui ogni (ristorante, giorno, famiglia) ha un contatore in memoria che
+distribuisce un LOTTO di unita' gia' prenotate a DB:
+
+- `riserva(rid, famiglia, n)`: se il lotto locale copre n, nessun I/O.
+  Altrimenti una RPC `ai_quota_riserva` fa compare-and-increment sulla riga
+  di `ai_quota_giornaliera` (UPDATE ... WHERE usati + n <= limite): o prende
+  tutto il lotto richiesto o niente, quindi processi diversi non possono
+  superare il limite insieme. La riga si inizializza in SQL, una volta al
+  giorno, dal COUNT di ai_usage_events: lo storico del giorno resta la base.
+- `conferma(prenotazione, effettivi)`: le unita' non usate tornano al lotto
+  locale (le usa la prossima chiamata dello stesso processo); quelle in piu'
+  (retry) si prendono a DB senza limite, perche' la spesa e' gia' avvenuta.
+
+Una prenotazione mai confermata resta consumata: errore per eccesso, mai
+per difetto. Il lotto non usato alla fine della giornata (o al riavvio) e'
+perso: al massimo `lotto` unita' per processo, ~1% del limite.
+
+Se la RPC non e' disponibile (migration non applicata, errore di rete) si
+torna al COUNT di sempre tramite ai_cost_service.get_daily_quota_status,
+senza bloccare. Lo stato dei contatori compare in worker_metrics.snapshot().
+"""
+
+from __future__ import annotations
+
+import threading
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from typing import Dict, List, Optional, Tuple
+
+from config.logger_setup import get_logger
+
+logger = get_logger('ai_quota')
+
+# famiglia → operation_type di ai_usage_events che la consumano
+FAMIGLIE: Dict[str, Tuple[str, ...]] = {
+    'categorization': ('categorization',),
+    'vision': ('pdf', 'vision'),
+}
+
+_RPC_RISERVA = "ai_quota_riserva"
+# Oltre, si dimentica il contatore meno recente (giornate passate, sedi inattive).
+_MAX_CONTATORI = 5000
+
+
+def limite_default(famiglia: str) -> int:
+    from config.constants import MAX_AI_CALLS_PER_DAY, VISION_DAILY_LIMIT
+
+    return VISION_DAILY_LIMIT if famiglia == 'vision' else MAX_AI_CALLS_PER_DAY
+
+
+def _lotto(limite: int) -> int:
+    # ~1% del limite: 10 per le categorizzazioni (1000), 1 per Vision (50).
+    return max(1, int(limite) // 100)
+
+
+def _oggi() -> str:
+    return datetime.now(timezone.utc).date().isoformat()
+
+
+@dataclass
+class Prenotazione:
+    ristorante_id: str
+    famiglia: str
+    giorno: str
+    n: int
+    concessa: bool
+    usati: int
+    limite: int
+    confermata: bool = False
+
+
+class _Contatore:
+    __slots__ = ("giorno", "usati_db", "lotto", "consumati", "concesse", "rifiutate",
+                 "ripieghi", "rpc_at", "lock")
+
+    def __init__(self, giorno: str):
+        self.giorno = giorno
+        self.usati_db = 0       # valore della riga DB all'ultima RPC (lotti inclusi)
+        self.lotto = 0          # unita' prenotate a DB e non ancora assegnate
+        self.consumati = 0      # unita' assegnate da questo processo oggi
+        self.concesse = 0
+        self.rifiutate = 0
+        self.ripieghi = 0       # prenotazioni risolte col COUNT per RPC non disponibile
+        self.rpc_at: Optional[str] = None
+        self.lock = threading.Lock()
+
+
+_contatori: Dict[Tuple[str, str], _Contatore] = {}
+_lock = threading.Lock()
+
+
+def _contatore(ristorante_id: str, famiglia: str, giorno: str) -> _Contatore:
+    chiave = (str(ristorante_id), famiglia)
+    with _lock:
+        c = _contatori.pop(chiave, None)
+        if c is None or c.giorno != giorno:
+            c = _Contatore(giorno)   # giorno nuovo: lotto e contatori ripartono
+        _contatori[chiave] = c       # in coda = piu' recente
+        while len(_contatori) > _MAX_CONTATORI:
+            _contatori.pop(next(iter(_contatori)))
+        return c
+
+
+def _rpc_riserva(ristorante_id: str, famiglia: str, n: int, limite: Optional[int]) -> Optional[Tuple[bool, int]]:
+    """(concessa, usati) dalla RPC, None se non disponibile."""
+    try:
+        from services import get_supabase_client
+
+        resp = get_supabase_client().rpc(_RPC_RISERVA, {
+            'p_ristorante_id': ristorante_id,
+            'p_famiglia': famiglia,
+            'p_operation_types': list(FAMIGLIE[famiglia]),
+            'p_n': int(n),
+            'p_limite': limite,
+        }).execute()
+    except Exception as exc:
+        logger.warning("Quota AI: RPC %s non disponibile (%s) — ripiego sul conteggio", _RPC_RISERVA, exc)
+        return None
+    rows = resp.data
+    if not isinstance(rows, list) or not rows or not isinstance(rows[0], dict):
+        return None
+    return bool(rows[0].get('concessa')), int(rows[0].get('usati') or 0)
+
+
+def riserva(ristorante_id: str, famiglia: str, n: int = 1, limite: Optional[int] = None) -> Prenotazione:
+    """Prenota `n` unita' della quota giornaliera; `concessa=False` se sforerebbe il limite."""
+    limite = limite_default(famiglia) if limite is None else int(limite)
+    n = max(1, int(n))
+    giorno = _oggi()
+    c = _contatore(ristorante_id, famiglia, giorno)
+
+    with c.lock:
+        if c.lotto < n:
+            manca = n - c.lotto
+            richiesta = max(manca, _lotto(limite))
+            esito = _rpc_riserva(ristorante_id, famiglia, richiesta, limite)
+            if esito is not None and not esito[0] and richiesta > manca:
+                # Il lotto intero non ci sta piu': basta il necessario.
+                richiesta = manca
+                esito = _rpc_riserva(ristorante_id, famiglia, richiesta, limite)
+            if esito is None:
+                return _riserva_con_conteggio(c, ristorante_id, famiglia, giorno, n, limite)
+            concessa, usati = esito
+            c.usati_db = usati
+            c.rpc_at = datetime.now(timezone.utc).isoformat()
+            if not concessa:
+                c.rifiutate += 1
+                return Prenotazione(ristorante_id, famiglia, giorno, n, False, usati, limite)
+            c.lotto += richiesta
+        c.lotto -= n
+        c.consumati += n
+        c.concesse += 1
+        return Prenotazione(ristorante_id, famiglia, giorno, n, True, c.usati_db - c.lotto, limite)
+
+
+def _riserva_con_conteggio(c: _Contatore, ristorante_id: str, famiglia: str, giorno: str,
+                           n: int, limite: int) -> Prenotazione:
+    from services.ai_cost_service import get_daily_quota_status
+
+    c.ripieghi += 1
+    quota = get_daily_quota_status(
+        ristorante_id=ristorante_id,
+        operation_types=list(FAMIGLIE[famiglia]),
+        daily_limit=limite,
+    )
+    concessa = not quota['is_exceeded']
+    if concessa:
+        c.concesse += 1
+    else:
+        c.rifiutate += 1
+    # confermata=True: nessun lotto da rettificare su questo percorso.
+    return Prenotazione(ristorante_id, famiglia, giorno, n, concessa, int(quota['used']), limite, confermata=True)
+
+
+def conferma(prenotazione: Optional[Prenotazione], effettivi: int) -> None:
+    """Chiude una prenotazione con le unita' davvero usate (restituisce o integra la differenza)."""
+    if prenotazione is None or not prenotazione.concessa or prenotazione.confermata:
+        return
+    prenotazione.confermata = True
+    delta = int(effettivi) - prenotazione.n
+    if delta == 0:
+        return
+    if prenotazione.giorno != _oggi():
+        return  # giornata chiusa: non si restituisce ne' si integra su quella nuova
+    c = _contatore(prenotazione.ristorante_id, prenotazione.famiglia, prenotazione.giorno)
+    with c.lock:
+        if delta < 0:
+            c.lotto += -delta
+            c.consumati += delta
+            return
+        if c.lotto >= delta:
+            c.lotto -= delta
+        else:
+            esito = _rpc_riserva(prenotazione.ristorante_id, prenotazione.famiglia, delta - c.lotto, None)
+            if esito is not None:
+                c.usati_db = esito[1]
+            c.lotto = 0
+        c.consumati += delta
+
+
+def stato() -> List[Dict[str, object]]:
+    """Contatori della giornata corrente, per worker_metrics / salute-worker."""
+    oggi = _oggi()
+    with _lock:
+        voci = [(k, c) for k, c in _contatori.items() if c.giorno == oggi]
+    out = []
+    for (rid, famiglia), c in voci:
+        out.append({
+            'ristorante_id': rid,
+            'famiglia': famiglia,
+            'usati_db': c.usati_db,
+            'lotto_locale': c.lotto,
+            'consumati_processo': c.consumati,
+            'concesse': c.concesse,
+            'rifiutate': c.rifiutate,
+            'ripieghi_conteggio': c.ripieghi,
+            'ultima_rpc': c.rpc_at,
+        })
+    out.sort(key=lambda r: r['consumati_processo'], reverse=True)
+    return out
+
+
+def reset() -> None:
+    with _lock:
+        _contatori.clear()
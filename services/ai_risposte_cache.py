@@ -0,0 +1,175 @@
+"""Cache persistente delle risposte GPT di categorizzazione, condivisa fra tenant.
+
+Problema: classifica_con_ai manda a OpenAI ogni descrizione che memoria e
+regole non risolvono. La stessa riga dello stesso fornitore ("MOZZARELLA FDL
+GR125X8", grossista X, IVA 4) arriva nella stessa settimana a decine di
+ristoranti e, finche' non viene promossa in prodotti_master, ognuno la paga e
+la aspetta da capo.
+
+Qui la risposta di GPT per un articolo si conserva in `ai_risposte_cache` con
+chiave SHA-256 di (descrizione normalizzata, fornitore, IVA, hint, versione
+prompt, modello). L'hint entra nella chiave perche' orienta la risposta: senza,
+una categoria "suggerita" a un tenant finirebbe a un altro che non l'aveva.
+
+- Versione prompt = hash del template di config/prompt_ai_potenziato: cambiare
+  il prompt (o le categorie, che vi sono elencate) invalida tutto senza
+  migration ne' pulizie manuali.
+- TTL (ONEFLUX_AI_CACHE_TTL_GIORNI, default 30, 0 = cache spenta): le voci piu'
+  vecchie si ignorano in lettura e si riscrivono al primo nuovo passaggio GPT.
+- Si salvano solo categorie valide restituite da GPT cosi' come sono: niente
+  "Da Classificare", niente recuperi via regole (che si riapplicano comunque a
+  valle, anche sulle risposte in cache).
+
+Ogni voce ricorda i token della chiamata che l'ha prodotta (quota per
+articolo), cosi' un hit puo' dichiarare in ai_usage_events quanti token ha
+risparmiato. Best-effort: qualunque errore equivale a "miss".
+"""
+
+from __future__ import annotations
+
+import hashlib
+import os
+import re
+from datetime import datetime, timedelta, timezone
+from functools import lru_cache
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from config.logger_setup import get_logger
+
+logger = get_logger('ai_risposte_cache')
+
+_TABELLA = "ai_risposte_cache"
+_TTL_GIORNI_DEFAULT = 30
+# Chiavi per IN(...) in una singola GET: 64 hex x 200 stanno ben sotto il
+# limite di lunghezza URL di PostgREST.
+_CHUNK_CHIAVI = 200
+
+_RE_SPAZI = re.compile(r'\s+')
+
+# (categoria, confidenza, token stimati per articolo)
+RispostaCache = Tuple[str, str, int]
+
+
+def ttl_giorni() -> int:
+    try:
+        return max(0, int(os.getenv("ONEFLUX_AI_CACHE_TTL_GIORNI", _TTL_GIORNI_DEFAULT)))
+    except (TypeError, ValueError):
+        return _TTL_GIORNI_DEFAULT
+
+
+@lru_cache(maxsize=1)
+def versione_prompt() -> str:
+    from config.prompt_ai_potenziato import PROMPT_CLASSIFICAZIONE_AI
+
+    return hashlib.sha256(PROMPT_CLASSIFICAZIONE_AI.encode('utf-8')).hexdigest()[:16]
+
+
+def _norm(testo) -> str:
+    return _RE_SPAZI.sub(' ', str(testo or '')).strip().upper()
+
+
+def chiave_risposta(
+    descrizione_normalizzata: str,
+    fornitore: Optional[str],
+    iva,
+    hint: Optional[str],
+    modello: str,
+) -> str:
+    try:
+        iva_norm = str(int(float(iva))) if iva not in (None, '') else ''
+    except (TypeError, ValueError):
+        iva_norm = ''
+    parti = (
+        _norm(descrizione_normalizzata), _norm(fornitore), iva_norm, _norm(hint),
+        versione_prompt(), modello,
+    )
+    return hashlib.sha256('\x1f'.join(parti).encode('utf-8')).hexdigest()
+
+
+def _client():
+    from services import get_supabase_client
+
+    return get_supabase_client()
+
+
+def leggi_risposte(chiavi: Iterable[str]) -> Dict[str, RispostaCache]:
+    """Risposte non scadute per le chiavi date (le assenti non compaiono)."""
+    giorni = ttl_giorni()
+    uniche = list(dict.fromkeys(c for c in chiavi if c))
+    if not giorni or not uniche:
+        return {}
+    soglia = (datetime.now(timezone.utc) - timedelta(days=giorni)).isoformat()
+    trovate: Dict[str, RispostaCache] = {}
+    try:
+        sb = _client()
+        for i in range(0, len(uniche), _CHUNK_CHIAVI):
+            resp = (
+                sb.table(_TABELLA)
+                .select("chiave, categoria, confidenza, token_stimati")
+                .in_("chiave", uniche[i:i + _CHUNK_CHIAVI])
+                .gte("updated_at", soglia)
+                .execute()
+            )
+            rows = resp.data
+            if not isinstance(rows, list):
+                return {}
+            for r in rows:
+                if r.get("chiave") and r.get("categoria"):
+                    trovate[r["chiave"]] = (
+                        r["categoria"], r.get("confidenza") or "media", int(r.get("token_stimati") or 0),
+                    )
+    except Exception as exc:
+        logger.warning("Cache risposte AI: lettura fallita (non bloccante): %s", exc)
+        return {}
+    return trovate
+
+
+def salva_risposte(voci: List[Dict[str, object]], modello: str) -> None:
+    """Upsert di voci {chiave, categoria, confidenza, token_stimati}."""
+    if not voci or not ttl_giorni():
+        return
+    adesso = datetime.now(timezone.utc).isoformat()
+    righe = [
+        {**v, "modello": modello, "versione_prompt": versione_prompt(), "updated_at": adesso}
+        for v in {v["chiave"]: v for v in voci}.values()
+    ]
+    try:
+        _client().table(_TABELLA).upsert(righe, on_conflict="chiave").execute()
+    except Exception as exc:
+        logger.warning("Cache risposte AI: scrittura fallita (non bloccante): %s", exc)
+
+
+def registra_esito(
+    ristorante_id: Optional[str],
+    modello: str,
+    hit: int,
+    miss: int,
+    token_risparmiati: int,
+) -> None:
+    """Evento 'categorization_cache' in ai_usage_events: hit rate e token risparmiati.
+
+    Costo zero e operation_type distinto da 'categorization': non consuma la
+    quota giornaliera e non sporca i costi, ma le dashboard ledger lo vedono.
+    """
+    if not hit:
+        return
+    try:
+        from services.ai_cost_service import track_ai_usage
+
+        track_ai_usage(
+            operation_type='categorization_cache',
+            prompt_tokens=0,
+            completion_tokens=0,
+            ristorante_id=ristorante_id,
+            item_count=hit,
+            model=modello,
+            metadata={
+                'cache_hit': hit,
+                'cache_miss': miss,
+                'hit_rate': round(hit / (hit + miss), 3),
+                'token_risparmiati': int(token_risparmiati),
+                'versione_prompt': versione_prompt(),
+            },
+        )
+    except Exception as exc:
+        logger.warning("Cache risposte AI: tracking esito fallito: %s", exc)
@@ -61,10 +61,11 @@ Pattern: Dependency Injection per testabilità
 import json
 import os
 import re
+import sys
 import threading
 import time
 from contextvars import ContextVar
-from datetime import datetime, timezone
+from datetime import datetime, timedelta, timezone
 from typing import Optional, Dict, List, Any, Tuple, Union
 import streamlit as st
 from tenacity import retry, stop_after_attempt, wait_exponential, retry_if_exception_type
@@ -145,6 +146,10 @@ from utils.text_utils import get_descrizione_normalizzata_e_originale, normalizz
 # user_id / ristorante_id esplicitamente senza dipendere dal contesto Streamlit.
 _ai_ctx_ristorante_id: ContextVar[Optional[str]] = ContextVar('ai_ctx_ristorante_id', default=None)
 _ai_ctx_user_id: ContextVar[Optional[str]] = ContextVar('ai_ctx_user_id', default=None)
+# Chiamate GPT fatte dalla classifica_con_ai in corso, per confermare la quota
+# prenotata (services/ai_quota). Lista condivisa: le copie di contesto dei
+# thread del dispatcher puntano allo stesso oggetto.
+_ai_ctx_chiamate_gpt: ContextVar[Optional[List[int]]] = ContextVar('ai_ctx_chiamate_gpt', default=None)
 
 
 def set_ai_context(ristorante_id: Optional[str] = None, user_id: Optional[str] = None) -> None:
@@ -178,6 +183,10 @@ def _resolve_user_id() -> Optional[str]:
     except Exception:
         return None
 from utils.validation import is_dicitura_sicura
+from utils.keyword_automaton import KeywordAutomaton
+from utils.supabase_paging import fetch_all_keyset
+from services import memoria_snapshot
+from services import cache_bus
 
 # Logger centralizzato
 from config.logger_setup import get_logger
@@ -201,8 +210,19 @@ RETRIABLE_ERRORS_PARSING = RETRIABLE_ERRORS + (ValueError,)
 _cache_lock = threading.Lock()
 _CACHE_TTL_SECONDS = 3600  # Ricarica la cache globale dopo 1 ora (evita memory leak a lungo termine)
 _REMOTE_VERSION_TTL_SECONDS = 30  # Polling cache_version DB ogni 30s per invalidazione cross-process
+_CACHE_VERSION_KEY = 'memoria_classificazione'
+# Bumpata dal trigger SOLO sui DELETE: un delta per watermark non vede le righe
+# cancellate, quindi quando cambia serve il reload completo.
+_CACHE_VERSION_KEY_DELETE = 'memoria_classificazione_delete'
+# Finestra di sovrapposizione sul watermark del delta: updated_at e' il now() di
+# INIZIO transazione, una transazione lenta puo' committare righe "nel passato"
+# rispetto all'ultimo updated_at di cache_version visto. Riapplicare righe gia'
+# viste e' innocuo (il delta e' idempotente).
+_DELTA_OVERLAP_SECONDS = 300
 _remote_version_state = {
     'last_seen_version': 0,    # ultima versione vista dal DB (sopravvive a invalida_cache_memoria)
+    'last_seen_delete_version': None,  # versione chiave _delete (None = chiave assente → niente delta)
+    'last_seen_updated_at': None,      # cache_version.updated_at (orologio DB) dell'ultima versione vista
     'last_checked_at': 0.0,    # timestamp ultimo SELECT su public.cache_version
 }
 _memoria_cache = {
@@ -216,7 +236,9 @@ _memoria_cache = {
     'version': 0,               # Incrementato ad ogni invalidazione
     'loaded': False,
     '_loaded_at': 0.0,          # Timestamp ultimo caricamento globale (TTL eviction)
-    '_loaded_user_ids': set()   # user_id già caricati (isola dati per utente)
+    '_loaded_user_ids': set(),  # user_id già caricati (isola dati per utente)
+    '_watermark': None,         # updated_at DB (ISO) fino a cui la cache e' aggiornata; None = niente delta
+    '_delta_richiesto': False,  # al prossimo accesso applica il delta invece del reload completo
 }
 
 # Flag per disabilitare la memoria globale (solo sessione)
@@ -2838,21 +2860,290 @@ _PAGE_SIZE = 1000  # Supabase default limit
 
 
 def _fetch_all_rows(supabase_client, table: str, select: str, filters: dict | None = None) -> list:
-    """Paginazione generica per superare il limite di 1000 righe di Supabase."""
-    all_rows = []
-    offset = 0
+    """Scansione completa paginata per `id` (keyset, vedi utils/supabase_paging).
+
+    Con l'offset ogni pagina di prodotti_master costava la scansione di tutte
+    le precedenti, e un upsert concorrente (il queue-worker che salva
+    classificazioni) poteva far saltare o ripetere righe fra una pagina e
+    l'altra. `id` viene aggiunto alla select se manca: serve da cursore.
+    """
+    colonne = [c.strip() for c in select.split(',')]
+    if 'id' not in colonne and '*' not in colonne:
+        select = f"{select}, id"
+
+    def query():
+        q = supabase_client.table(table).select(select)
+        for col, val in (filters or {}).items():
+            q = q.eq(col, val)
+        return q
+
+    # Nessun cap: la memoria deve essere completa (un troncamento qui
+    # significherebbe classificazioni AI al posto di quelle in memoria).
+    return fetch_all_keyset(query, page_size=_PAGE_SIZE, max_rows=sys.maxsize)
+
+
+def _voce_master(row: dict) -> Tuple[str, Any, bool]:
+    """Riga prodotti_master → (descrizione, categoria, bypass).
+
+    bypass=True (confidence alta/altissima o streak>=3) → la voce va in
+    prodotti_master e salta l'AI; altrimenti in prodotti_master_hint.
+    Condivisa da caricamento completo e delta: le due strade devono
+    smistare le righe nello stesso modo.
+    """
+    cat = _normalize_category_name(row.get('categoria')) or row.get('categoria')
+    conf = row.get('confidence')
+    streak = row.get('consecutive_correct_classifications', 0) or 0
+    return row['descrizione'], cat, (conf in ('alta', 'altissima') or streak >= 3)
+
+
+def _scarica_memoria_globale(supabase_client) -> Tuple[Dict[str, Any], bool]:
+    """Scarica la parte GLOBALE della memoria (prodotti_master, classificazioni_manuali,
+    brand_ambigui). Ritorna (parti, completa).
+
+    `parti` contiene solo le sezioni scaricate: una query fallita (o una tabella
+    vuota) lascia in cache il valore precedente, come sempre. `completa` e' False
+    se almeno una query e' fallita: in quel caso il risultato non va persistito
+    nello snapshot condiviso (services/memoria_snapshot).
+    """
+    parti: Dict[str, Any] = {}
+    completa = True
+    # Query 2: Carica TUTTA la memoria globale (paginata)
+    try:
+        rows_globale = _fetch_all_rows(
+            supabase_client, 'prodotti_master',
+            'descrizione, categoria, confidence, consecutive_correct_classifications'
+        )
+
+        if rows_globale:
+            _bypass = {}   # alta/altissima o streak>=3 → skip AI direttamente
+            _hint = {}     # media/None → passa come hint, AI ha l'ultima parola
+            _streak_promo = 0
+            for row in rows_globale:
+                desc, cat, bypass = _voce_master(row)
+                if bypass:
+                    _bypass[desc] = cat
+                    if row.get('confidence') not in ('alta', 'altissima'):
+                        _streak_promo += 1
+                else:
+                    _hint[desc] = cat
+            _bypass_canon, canon_conflicts = _build_master_canonical_map(_bypass)
+            parti['prodotti_master'] = _bypass
+            parti['prodotti_master_canon'] = _bypass_canon
+            parti['prodotti_master_hint'] = _hint
+            logger.info(
+                f"📦 Cache GLOBALE caricata: {len(_bypass)} bypass "
+                f"(alta/altissima + {_streak_promo} streak>=3), "
+                f"{len(_bypass_canon)} canonici (conflicts={canon_conflicts}), "
+                f"{len(_hint)} hint (media/None)"
+            )
+    except Exception as e:
+        logger.warning(f"Query 2 (prodotti_master) fallita: {e}")
+        completa = False
+
+    # Query 3: Carica TUTTE le classificazioni manuali admin (paginata)
+    try:
+        rows_manuali = _fetch_all_rows(
+            supabase_client, 'classificazioni_manuali',
+            'descrizione, categoria_corretta, is_dicitura'
+        )
+
+        if rows_manuali:
+            parti['classificazioni_manuali'] = {
+                row['descrizione']: {
+                    'categoria': (_normalize_category_name(row.get('categoria_corretta')) or row.get('categoria_corretta')),
+                    'is_dicitura': row.get('is_dicitura', False)
+                }
+                for row in rows_manuali
+            }
+            logger.info(f"📦 Cache MANUALI caricata: {len(rows_manuali)} classificazioni")
+    except Exception as e:
+        logger.warning(f"Query 3 (classificazioni_manuali) fallita: {e}")
+        completa = False
+
+    # Query 4: Carica brand ambigui dinamici da Supabase
+    try:
+        result_brand = supabase_client.table('brand_ambigui')\
+            .select('brand')\
+            .eq('aggiunto_automaticamente', True)\
+            .execute()
+        brand_dinamici = {row['brand'] for row in result_brand.data} if result_brand.data else set()
+        parti['brand_ambigui'] = brand_dinamici
+        if brand_dinamici:
+            logger.info(f"📦 Cache BRAND AMBIGUI caricata: {len(brand_dinamici)} brand dinamici")
+    except Exception as brand_err:
+        # Tabella potrebbe non esistere ancora (migration non eseguita)
+        logger.warning(f"⚠️ brand_ambigui non caricati (tabella assente?): {brand_err}")
+        parti['brand_ambigui'] = set()
+        completa = False
+
+    return parti, completa
+
+
+def _fetch_righe_modificate(supabase_client, table: str, select: str, dal: str) -> list:
+    """Righe di `table` con updated_at >= `dal`, paginate keyset su (updated_at, id).
+
+    Keyset e non offset: durante il delta le tabelle cambiano, e una riga
+    aggiornata a meta' paginazione sposterebbe le successive di una posizione
+    (con l'offset se ne salterebbe una). `select` deve includere id e updated_at.
+    """
+    righe: list = []
+    ultimo = None
     while True:
         q = supabase_client.table(table).select(select)
-        if filters:
-            for col, val in filters.items():
-                q = q.eq(col, val)
-        result = q.range(offset, offset + _PAGE_SIZE - 1).execute()
-        batch = result.data or []
-        all_rows.extend(batch)
+        if ultimo is None:
+            q = q.gte('updated_at', dal)
+        else:
+            u, i = ultimo
+            q = q.or_(f'updated_at.gt."{u}",and(updated_at.eq."{u}",id.gt.{i})')
+        batch = q.order('updated_at').order('id').limit(_PAGE_SIZE).execute().data or []
+        righe.extend(batch)
         if len(batch) < _PAGE_SIZE:
-            break
-        offset += _PAGE_SIZE
-    return all_rows
+            return righe
+        ultimo = (batch[-1]['updated_at'], batch[-1]['id'])
+
+
+def _patch_master(cache: Dict[str, Any], righe: list) -> None:
+    """Applica righe prodotti_master modificate a bypass/hint/canon in place.
+
+    La mappa canonica scarta le chiavi con categorie in conflitto: per
+    ricalcolare solo le chiavi toccate serve l'indice chiave → {descrizione:
+    categoria} dei bypass, costruito al primo delta dopo ogni caricamento
+    completo (un passaggio in RAM, nessuna query).
+    """
+    bypass = cache['prodotti_master']
+    hint = cache['prodotti_master_hint']
+    canon = cache['prodotti_master_canon']
+    membri = cache.get('_canon_membri')
+    if membri is None:
+        membri = {}
+        for d, c in bypass.items():
+            k = _build_master_canonical_key(d)
+            if k:
+                membri.setdefault(k, {})[d] = c
+        cache['_canon_membri'] = membri
+
+    toccate = set()
+    for row in righe:
+        desc, cat, is_bypass = _voce_master(row)
+        if is_bypass:
+            bypass[desc] = cat
+            hint.pop(desc, None)
+        else:
+            hint[desc] = cat
+            bypass.pop(desc, None)
+        k = _build_master_canonical_key(desc)
+        if not k:
+            continue
+        if is_bypass:
+            membri.setdefault(k, {})[desc] = cat
+        elif k in membri:
+            membri[k].pop(desc, None)
+        toccate.add(k)
+
+    # Stessa regola di _build_master_canonical_map: chiave valida solo se tutte
+    # le descrizioni che la producono concordano sulla categoria.
+    for k in toccate:
+        categorie = set((membri.get(k) or {}).values())
+        if len(categorie) == 1:
+            canon[k] = categorie.pop()
+        else:
+            canon.pop(k, None)
+            if not categorie:
+                membri.pop(k, None)
+
+
+def _applica_delta_memoria(supabase_client, watermark: str, nuovo_watermark: Optional[str]) -> bool:
+    """Aggiorna _memoria_cache con le sole righe cambiate dopo `watermark`.
+
+    Scarica da prodotti_master, classificazioni_manuali e prodotti_utente le
+    righe con updated_at >= watermark - _DELTA_OVERLAP_SECONDS e le applica
+    in place (bypass/hint/canon, manuali, mappe raw e _norm degli utenti gia'
+    caricati). Ritorna False se una query fallisce: il chiamante ripiega sul
+    reload completo. Le cancellazioni non passano di qui (vedi
+    _CACHE_VERSION_KEY_DELETE).
+    """
+    cache = _memoria_cache
+    utenti = set(cache.get('_loaded_user_ids') or ())
+    try:
+        dal = (
+            datetime.fromisoformat(str(watermark).replace('Z', '+00:00'))
+            - timedelta(seconds=_DELTA_OVERLAP_SECONDS)
+        ).isoformat()
+        righe_master = _fetch_righe_modificate(
+            supabase_client, 'prodotti_master',
+            'id, descrizione, categoria, confidence, consecutive_correct_classifications, updated_at', dal,
+        )
+        righe_manuali = _fetch_righe_modificate(
+            supabase_client, 'classificazioni_manuali',
+            'id, descrizione, categoria_corretta, is_dicitura, updated_at', dal,
+        )
+        righe_utente = _fetch_righe_modificate(
+            supabase_client, 'prodotti_utente',
+            'id, user_id, descrizione, categoria, updated_at', dal,
+        ) if utenti else []
+    except Exception as e:
+        logger.warning(f"Delta memoria fallito, ripiego su reload completo: {e}")
+        return False
+
+    with _cache_lock:
+        if cache is not _memoria_cache or not cache.get('loaded'):
+            # Invalidata mentre scaricavo: il prossimo accesso ricarica da zero.
+            return True
+        _patch_master(cache, righe_master)
+        manuali = cache['classificazioni_manuali']
+        for row in righe_manuali:
+            manuali[row['descrizione']] = {
+                'categoria': (_normalize_category_name(row.get('categoria_corretta')) or row.get('categoria_corretta')),
+                'is_dicitura': row.get('is_dicitura', False)
+            }
+        righe_utente_applicate = 0
+        for row in righe_utente:
+            uid = row.get('user_id')
+            desc = str(row.get('descrizione') or '').strip()
+            if uid not in utenti or not desc:
+                continue
+            categoria = _normalize_category_name(row.get('categoria')) or row.get('categoria')
+            cache['prodotti_utente'].setdefault(uid, {})[desc] = categoria
+            desc_normalized, _ = get_descrizione_normalizzata_e_originale(desc)
+            if desc_normalized:
+                cache['prodotti_utente_norm'].setdefault(uid, {})[desc_normalized] = categoria
+            righe_utente_applicate += 1
+        if nuovo_watermark:
+            cache['_watermark'] = nuovo_watermark
+        cache['version'] += 1
+    logger.info(
+        f"🔁 Delta memoria applicato: {len(righe_master)} master, {len(righe_manuali)} manuali, "
+        f"{righe_utente_applicate} locali (dal {dal})"
+    )
+    return True
+
+
+def _segnala_modifica_memoria():
+    """Dopo una scrittura su prodotti_master/prodotti_utente/classificazioni_manuali
+    da QUESTO processo: aggiorna la cache col delta al prossimo accesso invece di
+    buttarla (una correzione non deve costare un reload completo).
+
+    Senza watermark (cache non caricata, o cache_version senza chiave _delete)
+    ripiega su invalida_cache_memoria() come prima.
+    """
+    with _cache_lock:
+        delta_possibile = bool(_memoria_cache.get('loaded') and _memoria_cache.get('_watermark'))
+        if delta_possibile:
+            _memoria_cache['_delta_richiesto'] = True
+    if not delta_possibile:
+        invalida_cache_memoria()
+    else:
+        cache_bus.pubblica("memoria")
+
+
+def _forza_controllo_versione_memoria(_ristorante_id=None):
+    """Evento "memoria" da un altro processo (cache_bus): il prossimo accesso
+    rilegge subito cache_version invece di aspettare il polling da 30s. Delta o
+    reload completo li decide, come sempre, il confronto delle versioni."""
+    _remote_version_state['last_checked_at'] = 0.0
+
+
+cache_bus.registra("memoria", _forza_controllo_versione_memoria)
 
 
 def carica_memoria_completa(user_id: str, supabase_client=None) -> Dict[str, Any]:
@@ -2883,18 +3174,38 @@ def carica_memoria_completa(user_id: str, supabase_client=None) -> Dict[str, Any
                 except Exception:
                     sb_for_check = None
             if sb_for_check is not None:
-                resp = sb_for_check.table('cache_version').select('version').eq('key', 'memoria_classificazione').limit(1).execute()
-                if resp.data:
-                    remote_v = int(resp.data[0].get('version') or 0)
+                resp = sb_for_check.table('cache_version')\
+                    .select('key, version, updated_at')\
+                    .in_('key', [_CACHE_VERSION_KEY, _CACHE_VERSION_KEY_DELETE])\
+                    .execute()
+                righe_versione = {r.get('key'): r for r in (resp.data or [])}
+                riga_v = righe_versione.get(_CACHE_VERSION_KEY)
+                if riga_v:
+                    remote_v = int(riga_v.get('version') or 0)
+                    riga_del = righe_versione.get(_CACHE_VERSION_KEY_DELETE)
+                    remote_del = int(riga_del.get('version') or 0) if riga_del else None
                     last_seen = int(_remote_version_state.get('last_seen_version') or 0)
                     if remote_v > last_seen:
                         if last_seen > 0:
-                            logger.info(f"🔄 Cache version DB cambiata ({last_seen} → {remote_v}): invalidazione cross-process")
+                            # Solo INSERT/UPDATE dall'ultima versione vista → delta per
+                            # watermark. Un DELETE (o la chiave _delete assente: migration
+                            # non applicata) richiede il reload completo come prima.
+                            solo_upsert = (
+                                remote_del is not None
+                                and remote_del == _remote_version_state.get('last_seen_delete_version')
+                            )
                             with _cache_lock:
-                                _memoria_cache['loaded'] = False
-                                _memoria_cache['_loaded_at'] = 0.0
-                                _memoria_cache['_loaded_user_ids'] = set()
+                                if solo_upsert and _memoria_cache.get('loaded') and _memoria_cache.get('_watermark'):
+                                    logger.info(f"🔄 Cache version DB cambiata ({last_seen} → {remote_v}): delta incrementale")
+                                    _memoria_cache['_delta_richiesto'] = True
+                                else:
+                                    logger.info(f"🔄 Cache version DB cambiata ({last_seen} → {remote_v}): invalidazione cross-process")
+                                    _memoria_cache['loaded'] = False
+                                    _memoria_cache['_loaded_at'] = 0.0
+                                    _memoria_cache['_loaded_user_ids'] = set()
                         _remote_version_state['last_seen_version'] = remote_v
+                        _remote_version_state['last_seen_updated_at'] = riga_v.get('updated_at')
+                    _remote_version_state['last_seen_delete_version'] = remote_del
                 _remote_version_state['last_checked_at'] = now_ts
     except Exception as _ver_err:
         # Non bloccante: se la tabella non esiste (migration non eseguita) o errore di rete, log e prosegui.
@@ -2903,13 +3214,40 @@ def carica_memoria_completa(user_id: str, supabase_client=None) -> Dict[str, Any
     with _cache_lock:
         global_loaded = _memoria_cache['loaded']
         # TTL eviction: se la cache globale è scaduta, forza ricaricamento
+        # E' anche la rete di sicurezza del delta incrementale: ricarica tutto,
+        # mappe utente comprese, cosi' un'eventuale deriva non dura piu' di 1h.
         if global_loaded and (time.time() - _memoria_cache.get('_loaded_at', 0.0)) > _CACHE_TTL_SECONDS:
             logger.info("Cache globale scaduta (TTL 1h), forzo ricaricamento")
             _memoria_cache['loaded'] = False
             _memoria_cache['_loaded_at'] = 0.0
+            _memoria_cache['_loaded_user_ids'] = set()
+            _memoria_cache['_delta_richiesto'] = False
             global_loaded = False
+        # Il flag si consuma qui, sotto lock: un solo thread applica il delta, e
+        # un bump arrivato mentre scarica lo ri-accende per il giro successivo.
+        delta_richiesto = bool(global_loaded and _memoria_cache.get('_delta_richiesto'))
+        if delta_richiesto:
+            _memoria_cache['_delta_richiesto'] = False
+            watermark = _memoria_cache.get('_watermark')
+            nuovo_watermark = _remote_version_state.get('last_seen_updated_at')
         user_already_loaded = user_id in _memoria_cache.get('_loaded_user_ids', set())
 
+    if delta_richiesto:
+        sb_delta = supabase_client
+        if sb_delta is None:
+            try:
+                from services import get_supabase_client
+                sb_delta = get_supabase_client()
+            except Exception:
+                sb_delta = None
+        if sb_delta is None or not _applica_delta_memoria(sb_delta, watermark, nuovo_watermark):
+            with _cache_lock:
+                _memoria_cache['loaded'] = False
+                _memoria_cache['_loaded_at'] = 0.0
+                _memoria_cache['_loaded_user_ids'] = set()
+            global_loaded = False
+            user_already_loaded = False
+
     # I due stati sono gestiti indipendentemente nel try-block:
     # – global_loaded=False       → ricarica prodotti_master + classificazioni_manuali
     # – user_already_loaded=False → ricarica prodotti_utente per questo user_id
@@ -2960,77 +3298,43 @@ def carica_memoria_completa(user_id: str, supabase_client=None) -> Dict[str, Any
 
     # Carica dati GLOBALI solo se non già caricati
     if not global_loaded:
-        # Query 2: Carica TUTTA la memoria globale (paginata)
-        try:
-            rows_globale = _fetch_all_rows(
-                supabase_client, 'prodotti_master',
-                'descrizione, categoria, confidence, consecutive_correct_classifications'
-            )
-
-            if rows_globale:
-                _bypass = {}   # alta/altissima o streak>=3 → skip AI direttamente
-                _hint = {}     # media/None → passa come hint, AI ha l'ultima parola
-                _streak_promo = 0
-                for row in rows_globale:
-                    desc = row['descrizione']
-                    cat = _normalize_category_name(row.get('categoria')) or row.get('categoria')
-                    conf = row.get('confidence')
-                    streak = row.get('consecutive_correct_classifications', 0) or 0
-                    if conf in ('alta', 'altissima') or streak >= 3:
-                        _bypass[desc] = cat
-                        if streak >= 3 and conf not in ('alta', 'altissima'):
-                            _streak_promo += 1
-                    else:
-                        _hint[desc] = cat
-                _bypass_canon, canon_conflicts = _build_master_canonical_map(_bypass)
-                _memoria_cache['prodotti_master'] = _bypass
-                _memoria_cache['prodotti_master_canon'] = _bypass_canon
-                _memoria_cache['prodotti_master_hint'] = _hint
-                logger.info(
-                    f"📦 Cache GLOBALE caricata: {len(_bypass)} bypass "
-                    f"(alta/altissima + {_streak_promo} streak>=3), "
-                    f"{len(_bypass_canon)} canonici (conflicts={canon_conflicts}), "
-                    f"{len(_hint)} hint (media/None)"
+        parti = None
+        loaded_at = time.time()
+        # Watermark del delta: l'updated_at DB dell'ultima versione vista PRIMA di
+        # scaricare (conservativo: cio' che cambia durante il download viene
+        # riapplicato dal delta successivo). Senza chiave _delete niente delta.
+        watermark_caricamento = (
+            _remote_version_state.get('last_seen_updated_at')
+            if _remote_version_state.get('last_seen_delete_version') is not None
+            else None
+        )
+        # Snapshot condiviso fra i processi dello stesso container (opt-in con
+        # MEMORIA_SNAPSHOT_DIR): un solo processo scarica, gli altri mappano il
+        # file. Serve una versione DB nota, altrimenti non sapremmo quando il file
+        # e' stantio.
+        versione_db = int(_remote_version_state.get('last_seen_version') or 0)
+        if versione_db > 0 and memoria_snapshot.directory_snapshot():
+            try:
+                da_snapshot = memoria_snapshot.carica_o_costruisci(
+                    versione_db,
+                    lambda: _scarica_memoria_globale(supabase_client),
+                    max_eta_s=_CACHE_TTL_SECONDS,
                 )
-        except Exception as e:
-            logger.warning(f"Query 2 (prodotti_master) fallita: {e}")
-
-        # Query 3: Carica TUTTE le classificazioni manuali admin (paginata)
-        try:
-            rows_manuali = _fetch_all_rows(
-                supabase_client, 'classificazioni_manuali',
-                'descrizione, categoria_corretta, is_dicitura'
-            )
-
-            if rows_manuali:
-                _memoria_cache['classificazioni_manuali'] = {
-                    row['descrizione']: {
-                        'categoria': (_normalize_category_name(row.get('categoria_corretta')) or row.get('categoria_corretta')),
-                        'is_dicitura': row.get('is_dicitura', False)
-                    }
-                    for row in rows_manuali
-                }
-                logger.info(f"📦 Cache MANUALI caricata: {len(rows_manuali)} classificazioni")
-        except Exception as e:
-            logger.warning(f"Query 3 (classificazioni_manuali) fallita: {e}")
-
-        # Query 4: Carica brand ambigui dinamici da Supabase
-        try:
-            result_brand = supabase_client.table('brand_ambigui')\
-                .select('brand')\
-                .eq('aggiunto_automaticamente', True)\
-                .execute()
-            brand_dinamici = {row['brand'] for row in result_brand.data} if result_brand.data else set()
-            _memoria_cache['brand_ambigui'] = brand_dinamici
-            if brand_dinamici:
-                logger.info(f"📦 Cache BRAND AMBIGUI caricata: {len(brand_dinamici)} brand dinamici")
-        except Exception as brand_err:
-            # Tabella potrebbe non esistere ancora (migration non eseguita)
-            logger.warning(f"⚠️ brand_ambigui non caricati (tabella assente?): {brand_err}")
-            _memoria_cache['brand_ambigui'] = set()
-
+            except Exception as snap_err:
+                logger.warning(f"Snapshot memoria non disponibile, caricamento per-processo: {snap_err}")
+                da_snapshot = None
+            if da_snapshot is not None:
+                parti, loaded_at = da_snapshot
+        if parti is None:
+            parti, _completa = _scarica_memoria_globale(supabase_client)
+
+        _memoria_cache.update(parti)
+        _memoria_cache['_canon_membri'] = None
+        _memoria_cache['_watermark'] = watermark_caricamento
         _memoria_cache['loaded'] = True
-        _memoria_cache['_loaded_at'] = time.time()
+        # TTL dalla data di COSTRUZIONE dei dati, non dal momento in cui questo
+        # processo li ha mappati: con lo snapshot i dati possono essere gia' vecchi.
+        _memoria_cache['_loaded_at'] = loaded_at
 
     _memoria_cache['version'] += 1
     logger.info(f"✅ Cache caricata (v{_memoria_cache['version']}) per user {user_id[:8]}")
@@ -3057,9 +3361,12 @@ def invalida_cache_memoria():
             'version': (_memoria_cache.get('version', 0) + 1),
             'timestamp': None,
             '_loaded_at': 0.0,
-            '_loaded_user_ids': set()
+            '_loaded_user_ids': set(),
+            '_watermark': None,
+            '_delta_richiesto': False,
         }
     logger.info("🔄 Cache memoria invalidata")
+    cache_bus.pubblica("memoria")
 
 
 _STREAK_NON_PRECARICATO = object()
@@ -3202,7 +3509,7 @@ def aggiorna_streak_classificazione(
                 f"🚀 STREAK PROMO: '{descrizione[:60]}' → '{categoria_gpt}' "
                 f"(streak={now_streak}) promosso a bypass!"
             )
-            invalida_cache_memoria()
+            _segnala_modifica_memoria()
         else:
             logger.debug(
                 f"📈 Streak '{descrizione[:60]}': {now_streak} "
@@ -3649,32 +3956,55 @@ _KEYWORDS_CONTENITORI = frozenset({
     "SACCHETTI", "SACCHETTO", "SACCHI", "SACCO",
 })
 
-def _build_compiled_patterns() -> Tuple[list, list]:
-    """
-    Costruisce le liste di (pattern_compilato, categoria) ordinate per lunghezza keyword decrescente.
-    Chiamata UNA VOLTA all'import del modulo. Ritorna (patterns_alimenti, patterns_contenitori).
+def _pattern_keyword(keyword: str) -> "re.Pattern":
+    """Pattern di match per una keyword del dizionario.
 
     Il pattern boundary accetta anche cifre come separatore sinistro per gestire
     codici GDO con numeri incollati (es. "200CANGURINO", "G500STOP-TOAST").
     """
-    patterns_alimenti = []
-    patterns_contenitori = []
+    # Boundary sinistro: inizio stringa, whitespace, non-alfanumerico, O cifra (per codici GDO)
+    return re.compile(r'(?:^|[\s\W\d])' + re.escape(keyword) + r'(?:[\s\W]|$)')
+
+
+def _build_keyword_tables() -> Tuple[list, list]:
+    """
+    Liste di (keyword, categoria) ordinate per lunghezza keyword decrescente.
+    L'ordine E' la priorita': la prima keyword che matcha vince.
+    Ritorna (keyword_alimenti, keyword_contenitori).
+    """
+    keyword_alimenti = []
+    keyword_contenitori = []
 
     for keyword, categoria in sorted(DIZIONARIO_CORREZIONI.items(), key=lambda x: len(x[0]), reverse=True):
-        # Boundary sinistro: inizio stringa, whitespace, non-alfanumerico, O cifra (per codici GDO)
-        pattern = re.compile(r'(?:^|[\s\W\d])' + re.escape(keyword) + r'(?:[\s\W]|$)')
         if keyword in _KEYWORDS_CONTENITORI:
-            patterns_contenitori.append((pattern, categoria))
+            keyword_contenitori.append((keyword, categoria))
         else:
-            patterns_alimenti.append((pattern, categoria))
+            keyword_alimenti.append((keyword, categoria))
+
+    return keyword_alimenti, keyword_contenitori
 
-    return patterns_alimenti, patterns_contenitori
+
+def _build_compiled_patterns() -> Tuple[list, list]:
+    """
+    Costruisce le liste di (pattern_compilato, categoria) ordinate per lunghezza keyword decrescente.
+    Chiamata UNA VOLTA all'import del modulo. Ritorna (patterns_alimenti, patterns_contenitori).
+
+    Non e' piu' il percorso caldo (vedi _AUTOMA_DIZIONARIO): resta come
+    implementazione di riferimento per la verifica di equivalenza dell'automa.
+    """
+    keyword_alimenti, keyword_contenitori = _build_keyword_tables()
+    return (
+        [(_pattern_keyword(kw), cat) for kw, cat in keyword_alimenti],
+        [(_pattern_keyword(kw), cat) for kw, cat in keyword_contenitori],
+    )
 
 # Compilati una volta all'avvio (0 overhead nelle chiamate successive)
 try:
+    _KEYWORD_ALIMENTI, _KEYWORD_CONTENITORI = _build_keyword_tables()
     _PATTERNS_ALIMENTI, _PATTERNS_CONTENITORI = _build_compiled_patterns()
 except Exception as e:
     logger.error(f"Errore buildcompiledpatterns: {e}")
+    _KEYWORD_ALIMENTI, _KEYWORD_CONTENITORI = [], []
     _PATTERNS_ALIMENTI, _PATTERNS_CONTENITORI = [], []
 
 
@@ -3693,8 +4023,8 @@ def _collassa_doppie(testo: str) -> str:
     return _DOPPIE_RE.sub(r'\1', testo)
 
 
-def _build_patterns_collassati() -> Tuple[list, list]:
-    """Stessa logica di _build_compiled_patterns ma su keyword con doppie collassate.
+def _build_keyword_tables_collassate() -> Tuple[list, list]:
+    """Stessa logica di _build_keyword_tables ma su keyword con doppie collassate.
 
     Salta le keyword troppo corte (<=2 char dopo collasso) per non generare match
     troppo larghi, e quelle che collassando diventerebbero identiche a un'altra
@@ -3708,8 +4038,8 @@ def _build_patterns_collassati() -> Tuple[list, list]:
             continue
         collapsed_map[ck].add((keyword, categoria))
 
-    patterns_alimenti = []
-    patterns_contenitori = []
+    keyword_alimenti = []
+    keyword_contenitori = []
     for ck, items in collapsed_map.items():
         categorie = {cat for _kw, cat in items}
         # Se la forma collassata e' ambigua (piu' categorie) o coincide gia' con
@@ -3721,22 +4051,94 @@ def _build_patterns_collassati() -> Tuple[list, list]:
         # copre gia': inutile duplicarla.
         if any(ck == kw for kw, _ in items):
             continue
-        pattern = re.compile(r'(?:^|[\s\W\d])' + re.escape(ck) + r'(?:[\s\W]|$)')
         if any(kw in _KEYWORDS_CONTENITORI for kw, _ in items):
-            patterns_contenitori.append((pattern, categoria))
+            keyword_contenitori.append((ck, categoria))
         else:
-            patterns_alimenti.append((pattern, categoria))
-    # Ordina per lunghezza decrescente come i pattern principali
-    patterns_alimenti.sort(key=lambda x: len(x[0].pattern), reverse=True)
-    patterns_contenitori.sort(key=lambda x: len(x[0].pattern), reverse=True)
-    return patterns_alimenti, patterns_contenitori
+            keyword_alimenti.append((ck, categoria))
+    # Ordina per lunghezza decrescente come i pattern principali. La chiave resta
+    # la lunghezza della keyword ESCAPED (storicamente si ordinava su
+    # len(pattern.pattern)): cambiarla sposterebbe la priorita' fra keyword con
+    # caratteri speciali e quindi l'output.
+    keyword_alimenti.sort(key=lambda x: len(re.escape(x[0])), reverse=True)
+    keyword_contenitori.sort(key=lambda x: len(re.escape(x[0])), reverse=True)
+    return keyword_alimenti, keyword_contenitori
+
+
+def _build_patterns_collassati() -> Tuple[list, list]:
+    """Versione regex di _build_keyword_tables_collassate (riferimento, vedi sopra)."""
+    keyword_alimenti, keyword_contenitori = _build_keyword_tables_collassate()
+    return (
+        [(_pattern_keyword(ck), cat) for ck, cat in keyword_alimenti],
+        [(_pattern_keyword(ck), cat) for ck, cat in keyword_contenitori],
+    )
 
 try:
+    _KEYWORD_ALIMENTI_COLLASSATI, _KEYWORD_CONTENITORI_COLLASSATI = _build_keyword_tables_collassate()
     _PATTERNS_ALIMENTI_COLLASSATI, _PATTERNS_CONTENITORI_COLLASSATI = _build_patterns_collassati()
 except Exception as e:
     logger.error(f"Errore build_patterns_collassati: {e}")
+    _KEYWORD_ALIMENTI_COLLASSATI, _KEYWORD_CONTENITORI_COLLASSATI = [], []
     _PATTERNS_ALIMENTI_COLLASSATI, _PATTERNS_CONTENITORI_COLLASSATI = [], []
 
+
+# ── AUTOMA KEYWORD (una passata per descrizione) ────────────────────────────
+# Prima il match era un re.search per keyword, in ordine: su una riga che non
+# matcha nulla erano migliaia di ricerche. L'automa (utils/keyword_automaton)
+# trova tutte le keyword in UNA passata e ritorna il rango minimo. Alimenti e
+# contenitori stanno nello STESSO automa, alimenti prima: il rango minimo
+# riproduce da solo "cibi prima dei contenitori, keyword piu' lunga prima".
+# La tabella associata mappa rango -> (categoria, is_alimento).
+def _build_automa(alimenti: list, contenitori: list) -> Tuple[KeywordAutomaton, list]:
+    tabella = [(cat, True) for _kw, cat in alimenti] + [(cat, False) for _kw, cat in contenitori]
+    automa = KeywordAutomaton([kw for kw, _cat in alimenti] + [kw for kw, _cat in contenitori])
+    return automa, tabella
+
+
+_AUTOMA_DIZIONARIO, _TABELLA_DIZIONARIO = _build_automa(_KEYWORD_ALIMENTI, _KEYWORD_CONTENITORI)
+_AUTOMA_COLLASSATI, _TABELLA_COLLASSATI = _build_automa(
+    _KEYWORD_ALIMENTI_COLLASSATI, _KEYWORD_CONTENITORI_COLLASSATI
+)
+
+
+def _cerca_keyword_dizionario(desc_upper: str) -> Optional[Tuple[str, bool]]:
+    """(categoria, is_alimento) della keyword vincente, o None se nessun match.
+
+    Ordine: match esatto (alimenti, poi contenitori), poi fallback su doppie
+    collassate (alimenti, poi contenitori) — lo stesso dei 4 loop regex storici.
+    """
+    rango = _AUTOMA_DIZIONARIO.miglior_rango(' ' + desc_upper + ' ')
+    if rango is not None:
+        return _TABELLA_DIZIONARIO[rango]
+    rango = _AUTOMA_COLLASSATI.miglior_rango(' ' + _collassa_doppie(desc_upper) + ' ')
+    if rango is not None:
+        return _TABELLA_COLLASSATI[rango]
+    return None
+
+
+def _cerca_keyword_dizionario_regex(desc_upper: str) -> Optional[Tuple[str, bool]]:
+    """Implementazione storica a regex lineari di _cerca_keyword_dizionario.
+
+    NON usata nel percorso caldo: esiste per il test di equivalenza e per
+    scripts/bench_dizionario_automa.py. Deve restare identica al comportamento
+    pre-automa — se diverge, e' l'automa ad avere torto.
+    """
+    # Padding per garantire match ai bordi (i pattern usano boundary [\s\W])
+    desc_padded = ' ' + desc_upper + ' '
+    for pattern, categoria in _PATTERNS_ALIMENTI:
+        if pattern.search(desc_padded):
+            return categoria, True
+    for pattern, categoria in _PATTERNS_CONTENITORI:
+        if pattern.search(desc_padded):
+            return categoria, False
+    desc_padded_collassato = ' ' + _collassa_doppie(desc_upper) + ' '
+    for pattern, categoria in _PATTERNS_ALIMENTI_COLLASSATI:
+        if pattern.search(desc_padded_collassato):
+            return categoria, True
+    for pattern, categoria in _PATTERNS_CONTENITORI_COLLASSATI:
+        if pattern.search(desc_padded_collassato):
+            return categoria, False
+    return None
+
 # Regex controllo caratteri (compilata a livello modulo, non ad ogni chiamata)
 _CTRL_RE = re.compile(r'[\x00-\x08\x0b\x0c\x0e-\x1f\x7f]')
 
@@ -3861,7 +4263,8 @@ def applica_correzioni_dizionario(descrizione: str, categoria_ai: str) -> str:
     - Se trova SOLO un CONTENITORE (VASC, CONF, BUSTA, etc.), classifica MATERIALE DI CONSUMO
     - Ignora i contenitori se c'è un alimento presente
     
-    Usa pattern regex pre-compilati e pre-ordinati per lunghezza decrescente (ottimizzazione).
+    Usa un automa Aho-Corasick pre-compilato (una passata per descrizione) con
+    priorità per lunghezza keyword decrescente.
     
     Args:
         descrizione: testo descrizione prodotto
@@ -3881,33 +4284,21 @@ def applica_correzioni_dizionario(descrizione: str, categoria_ai: str) -> str:
     if any(brand in desc_upper for brand in _brand_set):
         return _post_regole_dominio(desc_upper, categoria_ai)
 
-    # Padding per garantire match ai bordi (i pattern usano boundary [\s\W])
-    desc_padded = ' ' + desc_upper + ' '
-
-    # STEP 1: Cerca ALIMENTI (priorità alta) - se trovi uno, ritorna subito.
+    # STEP 1: ALIMENTI (priorità alta) - se ce n'è uno, vince lui.
     # Regola dominio: se l'alimento e' ortofrutta MA trasformata/conservata
     # (concentrato, sciroppata, sottolio, in scatola...) → SCATOLAME E CONSERVE.
-    for pattern, categoria in _PATTERNS_ALIMENTI:
-        if pattern.search(desc_padded):
-            return _post_regole_dominio(desc_upper, categoria)
-
-    # STEP 2: Cerca CONTENITORI (priorità bassa) - solo se nessun alimento trovato
-    for pattern, categoria in _PATTERNS_CONTENITORI:
-        if pattern.search(desc_padded):
-            return categoria
-
+    # STEP 2: CONTENITORI (priorità bassa) - solo se nessun alimento trovato.
     # STEP 3: FALLBACK refusi tipografici (doppie). Solo se i match esatti sopra
     # hanno fallito: collasso le doppie nella descrizione e cerco tra le keyword
     # anch'esse collassate. Cattura es. "MOZZARELA"->LATTICINI, "POMODOLLO"->VERDURE
-    # senza poter rompere alcun match esatto preesistente (questo blocco non viene
-    # nemmeno raggiunto se sopra c'e' stato un match).
-    desc_padded_collassato = ' ' + _collassa_doppie(desc_upper) + ' '
-    for pattern, categoria in _PATTERNS_ALIMENTI_COLLASSATI:
-        if pattern.search(desc_padded_collassato):
+    # senza poter rompere alcun match esatto preesistente.
+    # Tutti e tre gli step sono risolti dall'automa in _cerca_keyword_dizionario.
+    trovato = _cerca_keyword_dizionario(desc_upper)
+    if trovato is not None:
+        categoria, is_alimento = trovato
+        if is_alimento:
             return _post_regole_dominio(desc_upper, categoria)
-    for pattern, categoria in _PATTERNS_CONTENITORI_COLLASSATI:
-        if pattern.search(desc_padded_collassato):
-            return categoria
+        return categoria
 
     # Nessun match dizionario: filtra comunque la proposta AI (es. AI dice FRUTTA
     # ma e' "pesche sciroppate" → SCATOLAME).
@@ -4159,8 +4550,8 @@ def salva_correzione_in_memoria_locale(
         else:
             logger.warning(f"⚠️ Upsert eseguito ma nessun dato restituito")
         
-        # Invalida cache per forzare ricaricamento
-        invalida_cache_memoria()
+        # Aggiorna la cache (delta al prossimo accesso, o reload se non possibile)
+        _segnala_modifica_memoria()
 
         # Tracking brand ambigui (silenzioso, non blocca il return)
         if vecchia_categoria:
@@ -4386,8 +4777,8 @@ def salva_correzione_in_memoria_globale(
                 'ultima_modifica': datetime.now(timezone.utc).isoformat()
             }).eq('id', record['id']).execute()
             
-            # Invalida cache per forzare ricaricamento
-            invalida_cache_memoria()
+            # Aggiorna la cache (delta al prossimo accesso, o reload se non possibile)
+            _segnala_modifica_memoria()
 
             # Tracking brand ambigui
             _aggiorna_brand_tracking(descrizione, vecchia_categoria, nuova_categoria, supabase_client)
@@ -4418,8 +4809,8 @@ def salva_correzione_in_memoria_globale(
                 'ultima_modifica': datetime.now(timezone.utc).isoformat()
             }).execute()
             
-            # Invalida cache per forzare ricaricamento
-            invalida_cache_memoria()
+            # Aggiorna la cache (delta al prossimo accesso, o reload se non possibile)
+            _segnala_modifica_memoria()
 
             # Tracking brand ambigui
             _aggiorna_brand_tracking(descrizione, vecchia_categoria, nuova_categoria, supabase_client)
@@ -4487,20 +4878,85 @@ def categorizza_con_memoria(
         str: categoria finale (default).
         Tuple[str, bool]: (categoria, is_fallback) se return_fallback_flag=True.
     """
-    global _memoria_cache
+    ctx = _prepara_contesto_categorizzazione(user_id, supabase_client, fornitore)
+    categoria, is_fallback = _categorizza_riga(
+        ctx,
+        descrizione,
+        prezzo,
+        quantita,
+        unita_misura=unita_misura,
+        iva_percentuale=iva_percentuale,
+        pending_local_saves=pending_local_saves,
+        totale_riga=totale_riga,
+    )
+    # I match veri (memoria/regole/fornitore/UM/dizionario) NON sono fallback.
+    return (categoria, is_fallback) if return_fallback_flag else categoria
 
-    def _ret(categoria: str, is_fallback: bool = False):
-        # I match veri (memoria/regole/fornitore/UM/dizionario) NON sono fallback.
-        return (categoria, is_fallback) if return_fallback_flag else categoria
 
-    # Il guardrail NOTE E DICITURE (dominio: consentita SOLO a totale_riga == 0,
-    # non a prezzo_unitario == 0 — es. un omaggio puo' avere prezzo di listino > 0
-    # ma totale_riga a zero per sconto 100%) deve valutare il vero importo della
-    # riga. Se il chiamante lo passa esplicitamente lo usiamo, altrimenti si
-    # ricade su 'prezzo' (comportamento storico, invariato per i chiamanti che
-    # non forniscono totale_riga).
-    _importo_guardrail = totale_riga if totale_riga is not None else prezzo
+def categorizza_batch(
+    righe: List[Dict[str, Any]],
+    user_id: Optional[str] = None,
+    fornitore: Optional[str] = None,
+    supabase_client=None,
+    pending_local_saves: Optional[List[Dict[str, Any]]] = None,
+) -> List[Tuple[str, bool]]:
+    """
+    Categorizza in blocco le righe di una fattura (o di un batch di coda).
+
+    Stesso risultato di `categorizza_con_memoria(..., return_fallback_flag=True)`
+    chiamata riga per riga — stessa funzione interna, stesse priorità — ma:
+    - client Supabase, override fornitore utenze, regola FORNITORE e caricamento
+      memoria sono risolti UNA volta per fornitore, non per riga;
+    - normalizzazione, chiave canonica, lookup memoria (admin/locale/globale),
+      regole forti e dizionario sono calcolati UNA volta per descrizione
+      distinta: le fatture GDO ripetono le stesse descrizioni decine di volte.
+
+    Args:
+        righe: dict con le chiavi di `categorizza_con_memoria`: 'descrizione',
+            'prezzo', 'quantita' (obbligatorie), 'unita_misura', 'iva_percentuale',
+            'totale_riga' (opzionali). Una chiave 'fornitore' per riga, se presente,
+            prevale su `fornitore` (batch di coda con più fatture).
+        user_id: ID utente (memoria locale + auto-save)
+        fornitore: fornitore di default per tutte le righe
+        supabase_client: client Supabase (opzionale)
+        pending_local_saves: buffer per il flush batch (vedi flush_pending_local_saves)
+
+    Returns:
+        List[Tuple[str, bool]]: (categoria, is_fallback) nello stesso ordine di `righe`.
+    """
+    contesti: Dict[Optional[str], Dict[str, Any]] = {}
+    risultati: List[Tuple[str, bool]] = []
+    for riga in righe:
+        fornitore_riga = riga.get('fornitore', fornitore)
+        ctx = contesti.get(fornitore_riga)
+        if ctx is None:
+            ctx = _prepara_contesto_categorizzazione(user_id, supabase_client, fornitore_riga)
+            # Client e memoria sono per-utente, non per-fornitore: li riuso.
+            supabase_client = ctx['supabase_client']
+            contesti[fornitore_riga] = ctx
+        risultati.append(_categorizza_riga(
+            ctx,
+            riga.get('descrizione') or '',
+            riga.get('prezzo'),
+            riga.get('quantita'),
+            unita_misura=riga.get('unita_misura'),
+            iva_percentuale=riga.get('iva_percentuale'),
+            pending_local_saves=pending_local_saves,
+            totale_riga=riga.get('totale_riga'),
+        ))
+    return risultati
+
+
+def _prepara_contesto_categorizzazione(
+    user_id: Optional[str],
+    supabase_client,
+    fornitore: Optional[str],
+) -> Dict[str, Any]:
+    """Decisioni di categorizza_con_memoria che dipendono solo da (utente, fornitore).
 
+    Calcolate una volta e riusate da `_categorizza_riga` per tutte le righe dello
+    stesso fornitore. `memo` accumula i risultati per descrizione distinta.
+    """
     # Usa client iniettato o fallback
     if supabase_client is None:
         try:
@@ -4509,23 +4965,32 @@ def categorizza_con_memoria(
         except Exception as e:
             logger.warning(f"Impossibile inizializzare Supabase client: {e}")
 
-    # LIVELLO 0: Hard override a livello fornitore per utility/telecom.
-    # Regola business: tutte le righe di questi fornitori vanno in UTENZE E LOCALI.
+    ctx: Dict[str, Any] = {
+        'user_id': user_id,
+        'supabase_client': supabase_client,
+        'fornitore': fornitore,
+        'utenze_match': None,
+        'categoria_fornitore': None,
+        'cache': None,
+        'memo': {},
+    }
+
     if fornitore:
+        # LIVELLO 0: Hard override a livello fornitore per utility/telecom.
+        # Regola business: tutte le righe di questi fornitori vanno in UTENZE E LOCALI.
         is_utility_supplier, matched_key = _is_fornitore_utenze_sempre(fornitore)
         if is_utility_supplier:
-            logger.info(
-                f"⚡ FORNITORE UTENZE HARD OVERRIDE: '{descrizione[:60]}' -> UTENZE E LOCALI "
-                f"(fornitore: {fornitore}, match: {matched_key})"
-            )
-            return _ret(_applica_guardrail_note_con_importo(descrizione, "UTENZE E LOCALI", _importo_guardrail))
+            ctx['utenze_match'] = (matched_key,)
+            # Nessuna riga arriverà alla memoria: non serve caricarla.
+            return ctx
 
-    # PROP-5: snapshot normalizzazione una sola volta (riusato in L2 + L3 + canon)
-    desc_stripped = descrizione.strip()
-    try:
-        desc_normalized, _ = get_descrizione_normalizzata_e_originale(desc_stripped)
-    except Exception:
-        desc_normalized = desc_stripped
+        # LIVELLO 5 (precalcolato): Regola FORNITORE specifico.
+        fornitore_upper = fornitore.strip().upper()
+        # PROP-6: usa tuple pre-normalizzata (no .upper() per riga, no import in hot path)
+        for fornitore_key_upper, categoria in _CATEGORIA_PER_FORNITORE_NORM:
+            if fornitore_key_upper in fornitore_upper or fornitore_upper in fornitore_key_upper:
+                ctx['categoria_fornitore'] = categoria
+                break
 
     try:
         # Carica cache se non già caricata per questo utente
@@ -4535,26 +5000,68 @@ def categorizza_con_memoria(
         # Snapshot locale: protegge da invalidazioni parallele durante la lettura.
         # Con integrazione invoicetronic (flusso multi-client parallelo), senza snapshot
         # un thread potrebbe leggere la cache già svuotata da un altro thread.
-        cache = _memoria_cache
+        ctx['cache'] = _memoria_cache
+    except Exception as e:
+        # Senza snapshot i livelli memoria (1-3) vengono saltati: si prosegue con
+        # dicitura/fornitore/UM/dizionario, come prima del refactor batch.
+        logger.warning(f"Errore check memoria admin (cache): {e}")
 
+    return ctx
+
+
+def _memo_descrizione(ctx: Dict[str, Any], descrizione: str) -> Dict[str, Any]:
+    """Stato per descrizione distinta (normalizzazione calcolata una volta sola)."""
+    memo = ctx['memo'].get(descrizione)
+    if memo is None:
+        # PROP-5: snapshot normalizzazione una sola volta (riusato in L2 + L3 + canon + auto-save)
+        desc_stripped = descrizione.strip()
+        try:
+            desc_normalized, _ = get_descrizione_normalizzata_e_originale(desc_stripped)
+            normalizzata_ok = True
+        except Exception:
+            desc_normalized = desc_stripped
+            normalizzata_ok = False
+        memo = {
+            'stripped': desc_stripped,
+            'normalized': desc_normalized,
+            'normalizzata_ok': normalizzata_ok,
+        }
+        ctx['memo'][descrizione] = memo
+    return memo
+
+
+def _cerca_in_memoria(ctx: Dict[str, Any], descrizione: str, memo: Dict[str, Any]) -> Optional[str]:
+    """Livelli 1-3 (admin, regole forti non negoziabili, locale, globale).
+
+    Dipendono solo dalla descrizione: il risultato viene memoizzato in `memo`
+    e riusato per le righe ripetute dello stesso batch. None = nessun match.
+    """
+    cache = ctx['cache']
+    if cache is None:
+        return None
+    user_id = ctx['user_id']
+    desc_stripped = memo['stripped']
+    desc_normalized = memo['normalized']
+
+    try:
         # LIVELLO 1: Check memoria admin (da cache, 0 query!)
         if desc_stripped in cache['classificazioni_manuali']:
             record = cache['classificazioni_manuali'][desc_stripped]
             if record.get('is_dicitura'):
                 logger.info(f"📋 Memoria Admin (cache): '{descrizione}' → DICITURA (validata admin)")
-                return _ret(_applica_guardrail_note_con_importo(descrizione, "📝 NOTE E DICITURE", _importo_guardrail))
+                return "📝 NOTE E DICITURE"
             else:
                 logger.info(f"📋 Memoria Admin (cache): '{descrizione}' → {record['categoria']} (validata admin)")
-                return _ret(_applica_guardrail_note_con_importo(descrizione, record['categoria'], _importo_guardrail))
+                return record['categoria']
 
         # LIVELLO 1.5: Override forti non negoziabili prima della memoria automatica.
         categoria_forzata, motivo_forzato = applica_regole_categoria_forti(descrizione, "Da Classificare")
         if motivo_forzato in _NON_NEGOZIABILI_CACHE_OVERRIDE:
-            return _ret(_applica_guardrail_note_con_importo(descrizione, categoria_forzata, _importo_guardrail))
-    
+            return categoria_forzata
+
     except Exception as e:
         logger.warning(f"Errore check memoria admin (cache): {e}")
-    
+
     # LIVELLO 2: Check memoria LOCALE utente (personalizzazioni cliente - priorità alta)
     try:
         if user_id and user_id in cache['prodotti_utente']:
@@ -4562,13 +5069,13 @@ def categorizza_con_memoria(
             if desc_stripped in locale_dict:
                 categoria = locale_dict[desc_stripped]
                 logger.info(f"🔵 LOCALE UTENTE (cache): '{descrizione}' → {categoria} (personalizzazione cliente)")
-                return _ret(_applica_guardrail_note_con_importo(descrizione, categoria, _importo_guardrail))
+                return categoria
 
             locale_dict_norm = cache.get('prodotti_utente_norm', {}).get(user_id, {})
             if desc_normalized in locale_dict_norm:
                 categoria = locale_dict_norm[desc_normalized]
                 logger.info(f"🔵 LOCALE UTENTE (cache): '{descrizione}' → {categoria} (personalizzazione cliente)")
-                return _ret(_applica_guardrail_note_con_importo(descrizione, categoria, _importo_guardrail))
+                return categoria
 
     except Exception as e:
         logger.warning(f"Errore check memoria locale utente (cache): {e}")
@@ -4579,7 +5086,7 @@ def categorizza_con_memoria(
             if desc_normalized in cache['prodotti_master']:
                 categoria = cache['prodotti_master'][desc_normalized]
                 logger.info(f"🟢 MEMORIA GLOBALE (cache): '{descrizione}' → {categoria} (norm: '{desc_normalized}')")
-                return _ret(_applica_guardrail_note_con_importo(descrizione, categoria, _importo_guardrail))
+                return categoria
 
             # PROP-2: fallback canonico (chiave robusta a varianti formato/quantita)
             master_canon = cache.get('prodotti_master_canon') or {}
@@ -4591,24 +5098,67 @@ def categorizza_con_memoria(
                         f"🟢 MEMORIA GLOBALE CANON (cache): '{descrizione}' → {categoria} "
                         f"(canon: '{canon_key}')"
                     )
-                    return _ret(_applica_guardrail_note_con_importo(descrizione, categoria, _importo_guardrail))
+                    return categoria
 
     except Exception as e:
         logger.warning(f"Errore check memoria globale (cache): {e}")
 
+    return None
+
+
+def _categorizza_riga(
+    ctx: Dict[str, Any],
+    descrizione: str,
+    prezzo: float,
+    quantita: float,
+    unita_misura: Optional[str] = None,
+    iva_percentuale: Optional[float] = None,
+    pending_local_saves: Optional[List[Dict[str, Any]]] = None,
+    totale_riga: Optional[float] = None,
+) -> Tuple[str, bool]:
+    """Cuore di categorizza_con_memoria / categorizza_batch per UNA riga.
+
+    Ritorna sempre (categoria, is_fallback). Vedi categorizza_con_memoria per
+    l'ordine dei livelli.
+    """
+    user_id = ctx['user_id']
+    supabase_client = ctx['supabase_client']
+    fornitore = ctx['fornitore']
+
+    # Il guardrail NOTE E DICITURE (dominio: consentita SOLO a totale_riga == 0,
+    # non a prezzo_unitario == 0 — es. un omaggio puo' avere prezzo di listino > 0
+    # ma totale_riga a zero per sconto 100%) deve valutare il vero importo della
+    # riga. Se il chiamante lo passa esplicitamente lo usiamo, altrimenti si
+    # ricade su 'prezzo' (comportamento storico, invariato per i chiamanti che
+    # non forniscono totale_riga).
+    _importo_guardrail = totale_riga if totale_riga is not None else prezzo
+
+    # LIVELLO 0: Hard override a livello fornitore per utility/telecom.
+    if ctx['utenze_match'] is not None:
+        logger.info(
+            f"⚡ FORNITORE UTENZE HARD OVERRIDE: '{descrizione[:60]}' -> UTENZE E LOCALI "
+            f"(fornitore: {fornitore}, match: {ctx['utenze_match'][0]})"
+        )
+        return _applica_guardrail_note_con_importo(descrizione, "UTENZE E LOCALI", _importo_guardrail), False
+
+    memo = _memo_descrizione(ctx, descrizione)
+
+    # LIVELLI 1-3: memoria admin / regole non negoziabili / locale / globale
+    if 'memoria' not in memo:
+        memo['memoria'] = _cerca_in_memoria(ctx, descrizione, memo)
+    if memo['memoria'] is not None:
+        return _applica_guardrail_note_con_importo(descrizione, memo['memoria'], _importo_guardrail), False
+
     # LIVELLO 4: Check dicitura (se prezzo = 0)
     if prezzo == 0 and is_dicitura_sicura(descrizione, prezzo, quantita):
-        return _ret(_applica_guardrail_note_con_importo(descrizione, "📝 NOTE E DICITURE", _importo_guardrail))
+        return _applica_guardrail_note_con_importo(descrizione, "📝 NOTE E DICITURE", _importo_guardrail), False
 
-    # LIVELLO 5: Regola FORNITORE specifico (priorità ALTA)
-    if fornitore:
-        fornitore_upper = fornitore.strip().upper()
-        # PROP-6: usa tuple pre-normalizzata (no .upper() per riga, no import in hot path)
-        for fornitore_key_upper, categoria in _CATEGORIA_PER_FORNITORE_NORM:
-            if fornitore_key_upper in fornitore_upper or fornitore_upper in fornitore_key_upper:
-                logger.info(f"🏭 FORNITORE: '{descrizione}' → {categoria} (fornitore: {fornitore})")
-                # BUG4 FIX: guardrail applicato anche su uscite FORNITORE/UM (difensivo)
-                return _ret(_applica_guardrail_note_con_importo(descrizione, categoria, _importo_guardrail))
+    # LIVELLO 5: Regola FORNITORE specifico (priorità ALTA, match precalcolato nel contesto)
+    if ctx['categoria_fornitore'] is not None:
+        categoria = ctx['categoria_fornitore']
+        logger.info(f"🏭 FORNITORE: '{descrizione}' → {categoria} (fornitore: {fornitore})")
+        # BUG4 FIX: guardrail applicato anche su uscite FORNITORE/UM (difensivo)
+        return _applica_guardrail_note_con_importo(descrizione, categoria, _importo_guardrail), False
 
     # LIVELLO 6: Regola UNITÀ MISURA (priorità ALTA)
     if unita_misura:
@@ -4617,11 +5167,14 @@ def categorizza_con_memoria(
             categoria = UNITA_MISURA_CATEGORIA[unita_upper]
             logger.info(f"📏 UNITÀ MISURA: '{descrizione}' → {categoria} (U.M.: {unita_misura})")
             # BUG4 FIX: guardrail applicato anche su uscite FORNITORE/UM (difensivo)
-            return _ret(_applica_guardrail_note_con_importo(descrizione, categoria, _importo_guardrail))
-    
-    # LIVELLO 7: Dizionario keyword (fallback)
-    categoria_keyword = applica_correzioni_dizionario(descrizione, "Da Classificare")
-    categoria_keyword, motivo_override = applica_regole_categoria_forti(descrizione, categoria_keyword)
+            return _applica_guardrail_note_con_importo(descrizione, categoria, _importo_guardrail), False
+
+    # LIVELLO 7: Dizionario keyword (fallback). Dizionario + regole forti dipendono
+    # solo dalla descrizione (memoizzati); i guardrail dipendono da importo/IVA.
+    if 'keyword' not in memo:
+        categoria_keyword = applica_correzioni_dizionario(descrizione, "Da Classificare")
+        memo['keyword'] = applica_regole_categoria_forti(descrizione, categoria_keyword)
+    categoria_keyword, motivo_override = memo['keyword']
     # A1: usa helper centralizzato per applicare entrambi i guardrail in sequenza
     categoria_keyword = _applica_tutti_guardrail(descrizione, categoria_keyword, _importo_guardrail, iva_percentuale)
     if motivo_override:
@@ -4641,8 +5194,9 @@ def categorizza_con_memoria(
             # 🔑 BUG-3 FIX: chiave coerente con `salva_correzione_in_memoria_locale`:
             # salvo sempre la descrizione normalizzata, così i match L1 (raw e norm)
             # combaciano sempre con le entry create manualmente dal cliente.
-            desc_norm_save, _ = get_descrizione_normalizzata_e_originale(descrizione.strip())
-            desc_local = desc_norm_save.replace('\x00', '').strip()[:MAX_DESC_LENGTH_DB]
+            if not memo['normalizzata_ok']:
+                raise ValueError("normalizzazione descrizione fallita")
+            desc_local = memo['normalized'].replace('\x00', '').strip()[:MAX_DESC_LENGTH_DB]
             if not desc_local:
                 logger.warning("Descrizione vuota dopo normalizzazione, skip auto-save locale")
             elif pending_local_saves is not None:
@@ -4687,7 +5241,7 @@ def categorizza_con_memoria(
     # is_fallback=True solo quando la categoria deriva ESCLUSIVAMENTE dal fallback
     # forzato (nessun match in memoria/regole/fornitore/UM/dizionario). In quel caso
     # il chiamante deve passarla all'AI invece di trattarla come classificata.
-    return _ret(categoria_finale, is_fallback=fallback_forzato)
+    return categoria_finale, fallback_forzato
 
 
 # NB: `svuota_memoria_globale` è stata rimossa (audit Bug 3/8/2026). Cancellava in
@@ -4733,49 +5287,48 @@ def _mappa_categorie_ai_per_idx(dati: Dict[str, Any]) -> Tuple[Dict[int, str], D
     return cat_by_idx, conf_by_idx
 
 
-@retry(
-    stop=stop_after_attempt(3),
-    wait=wait_exponential(multiplier=1, min=2, max=30),
-    retry=retry_if_exception_type(RETRIABLE_ERRORS_PARSING)
-)
-def _chiama_gpt_classificazione(
+def _modello_classificazione() -> str:
+    # Decisione di dominio (A/B test 5/7/2026 su 213 correzioni manuali reali,
+    # vedi scripts/ab_test_modello_categorizzazione.py): gpt-4.1-mini +5.1 punti
+    # di accuratezza (44.1% vs 39.0%) rispetto a gpt-4o-mini, costo +~0.50€/cliente/mese
+    # (~2.7x piu' costoso — vedi ai_cost_service._MODEL_TARIFFE). Trascurabile a
+    # regime (10-20 clienti), accettato.
+    return os.getenv("ONEFLUX_AI_MODEL", "gpt-4.1-mini")
+
+
+_MAX_DESC_LEN_GPT = 300
+
+
+def _descrizione_per_gpt(desc: str) -> str:
+    """Testo dell'articolo come finisce nel payload GPT (e nella chiave della cache risposte)."""
+    from utils.text_utils import normalizza_descrizione
+
+    # 🔒 Sanitizza input: rimuovi caratteri di controllo, limita lunghezza per descrizione
+    sanitizzata = _CTRL_RE.sub('', desc)[:_MAX_DESC_LEN_GPT]
+    # 🧹 Normalizza descrizioni per rimuovere prefissi GDO (es: "G100 PANBURGER" → "PANBURGER")
+    # ed espandere abbreviazioni (es: "INS.NOVELLA" → "INSALATA NOVELLA").
+    return normalizza_descrizione(sanitizzata) or sanitizzata  # fallback a originale se normalizzazione svuota
+
+
+def _componi_prompt_classificazione(
     da_chiedere_gpt: List[str],
-    openai_client,
-    max_tokens: int = 4096,
     lista_fornitori: Optional[List[str]] = None,
     lista_iva: Optional[List[int]] = None,
     lista_hint: Optional[List[Optional[str]]] = None,
-    return_confidenze: bool = False,
-) -> Union[List[str], Tuple[List[str], List[str]]]:
-    """
-    Singola chiamata GPT per classificazione. Ritorna lista categorie (stesso ordine input).
-    Se GPT ritorna meno categorie del previsto, le mancanti saranno "Da Classificare".
+) -> Tuple[str, List[str], int]:
+    """Prompt GPT per un batch: (prompt, descrizioni normalizzate, item con hint).
 
-    Quando lista_fornitori e/o lista_iva sono fornite (allineate con da_chiedere_gpt),
-    il payload inviato a GPT è arricchito: {articolo, fornitore, iva} invece di semplici stringhe.
-    Le descrizioni vengono inoltre normalizzate (rimozione prefissi peso GDO, espansione
-    abbreviazioni) prima di essere inviate, per migliorare l'accuratezza.
+    Condiviso fra la chiamata sincrona e i job batch notturni
+    (services/ai_batch_notturno), che devono inviare esattamente lo stesso testo.
     """
     from config.prompt_ai_potenziato import get_prompt_classificazione
-    from utils.text_utils import normalizza_descrizione
 
-    # 🔒 Sanitizza input: rimuovi caratteri di controllo, limita lunghezza per descrizione
-    _MAX_DESC_LEN = 300
     # Nota: non si verifica esplicitamente il conteggio token in input. Con batch_size=30 e
     # descrizioni troncate a 300 char, il payload stimato rimane entro ~6-7k token —
     # ampiamente sotto il limite 128k di gpt-4o-mini.
-    da_chiedere_sanitized = [
-        _CTRL_RE.sub('', desc)[:_MAX_DESC_LEN] for desc in da_chiedere_gpt
-    ]
-
-    # 🧹 Normalizza descrizioni per rimuovere prefissi GDO (es: "G100 PANBURGER" → "PANBURGER")
-    # ed espandere abbreviazioni (es: "INS.NOVELLA" → "INSALATA NOVELLA").
     # Usiamo la versione normalizzata SOLO nel payload inviato a GPT; la mappatura risultati
     # avviene per indice, quindi il cambio di testo non crea disallineamenti.
-    da_chiedere_normalizzate = [
-        normalizza_descrizione(desc) or desc  # fallback a originale se normalizzazione svuota
-        for desc in da_chiedere_sanitized
-    ]
+    da_chiedere_normalizzate = [_descrizione_per_gpt(desc) for desc in da_chiedere_gpt]
 
     # 📦 Costruisci payload: arricchito (dict) se i metadati sono disponibili, altrimenti plain list
     _ha_fornitori = lista_fornitori and len(lista_fornitori) == len(da_chiedere_gpt)
@@ -4813,25 +5366,126 @@ def _chiama_gpt_classificazione(
         articoli_json = json.dumps(payload, ensure_ascii=False)
 
     prompt = get_prompt_classificazione(articoli_json)
-    
-    # Decisione di dominio (A/B test 5/7/2026 su 213 correzioni manuali reali,
-    # vedi scripts/ab_test_modello_categorizzazione.py): gpt-4.1-mini +5.1 punti
-    # di accuratezza (44.1% vs 39.0%) rispetto a gpt-4o-mini, costo +~0.50€/cliente/mese
-    # (~2.7x piu' costoso — vedi ai_cost_service._MODEL_TARIFFE). Trascurabile a
-    # regime (10-20 clienti), accettato.
-    _model = os.getenv("ONEFLUX_AI_MODEL", "gpt-4.1-mini")
-    response = openai_client.chat.completions.create(
-        model=_model,
-        messages=[{"role": "user", "content": prompt}],
-        max_tokens=max_tokens,
-        temperature=0.1,
-        response_format={"type": "json_object"}
+    return prompt, da_chiedere_normalizzate, _items_with_hint
+
+
+def _richiesta_classificazione(prompt: str, max_tokens: int = 4096) -> Dict[str, Any]:
+    """Parametri di chat.completions.create (anche `body` delle righe JSONL batch)."""
+    return {
+        "model": _modello_classificazione(),
+        "messages": [{"role": "user", "content": prompt}],
+        "max_tokens": max_tokens,
+        "temperature": 0.1,
+        "response_format": {"type": "json_object"},
+    }
+
+
+def _esiti_classificazione(
+    cat_by_idx: Dict[int, str],
+    conf_by_idx: Dict[int, str],
+    da_chiedere_gpt: List[str],
+) -> Tuple[List[str], List[str], List[Dict[str, Any]]]:
+    """Valida la risposta GPT mappando per IDX: (categorie, confidenze, voci da memorizzare)."""
+    risultati = []
+    confidenze_out = []
+    mancanti = 0
+    da_memorizzare: List[Dict[str, Any]] = []
+    for idx, desc in enumerate(da_chiedere_gpt):
+        cat = cat_by_idx.get(idx)
+        if cat is None:
+            # l'AI non ha restituito QUESTO idx: NON slittiamo, lo marchiamo aperto
+            logger.warning(f"⚠️ AI non ha restituito idx {idx}: '{desc[:40]}' → Da Classificare")
+            risultati.append("Da Classificare")
+            confidenze_out.append("bassa")
+            mancanti += 1
+            continue
+
+        # ⚠️ VALIDAZIONE: Blocca categorie non valide (incluso NOTE E DICITURE)
+        # Fix B1: recupero a 2 stadi (regole forti → dizionario) invece del solo
+        # dizionario. Le regole forti sono più precise, quindi una categoria GPT
+        # vietata (es. NOTE E DICITURE) viene rimappata a una categoria reale più
+        # spesso, evitando di degradare a "Da Classificare" e innescare retry inutili.
+        if cat not in TUTTE_LE_CATEGORIE and cat != "Da Classificare":
+            logger.warning(f"⚠️ AI ha generato categoria non valida '{cat}' per '{desc}' → recupero regole forti/dizionario")
+            cat_recuperata, _motivo_rec = applica_regole_categoria_forti(desc, "Da Classificare")
+            if cat_recuperata == "Da Classificare":
+                cat_recuperata = applica_correzioni_dizionario(desc, "Da Classificare")
+            cat = cat_recuperata
+        elif cat != "Da Classificare":
+            da_memorizzare.append({"idx": idx, "categoria": cat})
+        risultati.append(cat)
+
+        conf = conf_by_idx.get(idx) or "media"
+        if conf not in ("alta", "media", "bassa"):
+            conf = "media"
+        confidenze_out.append(conf)
+
+    if mancanti or len(cat_by_idx) != len(da_chiedere_gpt):
+        logger.warning(
+            f"⚠️ ALLINEAMENTO: inviati {len(da_chiedere_gpt)} articoli, "
+            f"ricevuti {len(cat_by_idx)} idx validi, {mancanti} non mappati "
+            f"(→ Da Classificare, NESSUNO slittamento)"
+        )
+
+    return risultati, confidenze_out, da_memorizzare
+
+
+@retry(
+    stop=stop_after_attempt(3),
+    wait=wait_exponential(multiplier=1, min=2, max=30),
+    retry=retry_if_exception_type(RETRIABLE_ERRORS_PARSING)
+)
+def _chiama_gpt_classificazione(
+    da_chiedere_gpt: List[str],
+    openai_client,
+    max_tokens: int = 4096,
+    lista_fornitori: Optional[List[str]] = None,
+    lista_iva: Optional[List[int]] = None,
+    lista_hint: Optional[List[Optional[str]]] = None,
+    return_confidenze: bool = False,
+) -> Union[List[str], Tuple[List[str], List[str]]]:
+    """
+    Singola chiamata GPT per classificazione. Ritorna lista categorie (stesso ordine input).
+    Se GPT ritorna meno categorie del previsto, le mancanti saranno "Da Classificare".
+
+    Quando lista_fornitori e/o lista_iva sono fornite (allineate con da_chiedere_gpt),
+    il payload inviato a GPT è arricchito: {articolo, fornitore, iva} invece di semplici stringhe.
+    Le descrizioni vengono inoltre normalizzate (rimozione prefissi peso GDO, espansione
+    abbreviazioni) prima di essere inviate, per migliorare l'accuratezza.
+    """
+    prompt, da_chiedere_normalizzate, _items_with_hint = _componi_prompt_classificazione(
+        da_chiedere_gpt, lista_fornitori, lista_iva, lista_hint,
     )
+    _ha_fornitori = lista_fornitori and len(lista_fornitori) == len(da_chiedere_gpt)
+    _ha_iva = lista_iva and len(lista_iva) == len(da_chiedere_gpt)
+    _ha_hint = lista_hint and len(lista_hint) == len(da_chiedere_gpt)
+    
+    _model = _modello_classificazione()
+    # ⏱️ Limiti OpenAI condivisi (services/gpt_dispatcher): token bucket RPM/TPM e
+    # pausa 429 comune a thread e processi, cosi' i batch in parallelo non si
+    # prendono a vicenda il 429.
+    from services import gpt_dispatcher
+
+    gpt_dispatcher.attendi_slot(gpt_dispatcher.stima_token(prompt) + max_tokens)
+    try:
+        response = openai_client.chat.completions.create(**_richiesta_classificazione(prompt, max_tokens))
+    except Exception as exc:
+        if gpt_dispatcher.e_rate_limit(exc):
+            gpt_dispatcher.segnala_429(exc)
+        raise
+    gpt_dispatcher.segnala_successo()
+    _chiamate = _ai_ctx_chiamate_gpt.get()
+    if _chiamate is not None:
+        _chiamate.append(1)
     
     # 💰 TRACKING COSTI AI - Categorizzazione
+    _token_per_articolo = 0
     try:
         usage = response.usage
         if usage:
+            _token_per_articolo = round(
+                ((usage.prompt_tokens or 0) + (usage.completion_tokens or 0)) / max(1, len(da_chiedere_gpt))
+            )
             from services.ai_cost_service import track_ai_usage
 
             track_ai_usage(
@@ -4873,44 +5527,28 @@ def _chiama_gpt_classificazione(
     dati = json.loads(testo)
     cat_by_idx, conf_by_idx = _mappa_categorie_ai_per_idx(dati)
 
-    # Valida e costruisci lista risultati + confidenze, mappando per IDX
-    risultati = []
-    confidenze_out = []
-    mancanti = 0
-    for idx, desc in enumerate(da_chiedere_gpt):
-        cat = cat_by_idx.get(idx)
-        if cat is None:
-            # l'AI non ha restituito QUESTO idx: NON slittiamo, lo marchiamo aperto
-            logger.warning(f"⚠️ AI non ha restituito idx {idx}: '{desc[:40]}' → Da Classificare")
-            risultati.append("Da Classificare")
-            confidenze_out.append("bassa")
-            mancanti += 1
-            continue
+    risultati, confidenze_out, da_memorizzare = _esiti_classificazione(cat_by_idx, conf_by_idx, da_chiedere_gpt)
 
-        # ⚠️ VALIDAZIONE: Blocca categorie non valide (incluso NOTE E DICITURE)
-        # Fix B1: recupero a 2 stadi (regole forti → dizionario) invece del solo
-        # dizionario. Le regole forti sono più precise, quindi una categoria GPT
-        # vietata (es. NOTE E DICITURE) viene rimappata a una categoria reale più
-        # spesso, evitando di degradare a "Da Classificare" e innescare retry inutili.
-        if cat not in TUTTE_LE_CATEGORIE and cat != "Da Classificare":
-            logger.warning(f"⚠️ AI ha generato categoria non valida '{cat}' per '{desc}' → recupero regole forti/dizionario")
-            cat_recuperata, _motivo_rec = applica_regole_categoria_forti(desc, "Da Classificare")
-            if cat_recuperata == "Da Classificare":
-                cat_recuperata = applica_correzioni_dizionario(desc, "Da Classificare")
-            cat = cat_recuperata
-        risultati.append(cat)
-
-        conf = conf_by_idx.get(idx) or "media"
-        if conf not in ("alta", "media", "bassa"):
-            conf = "media"
-        confidenze_out.append(conf)
+    # Solo le categorie valide arrivate cosi' da GPT entrano nella cache
+    # risposte condivisa (services/ai_risposte_cache).
+    if da_memorizzare:
+        from services.ai_risposte_cache import chiave_risposta, salva_risposte
 
-    if mancanti or len(cat_by_idx) != len(da_chiedere_gpt):
-        logger.warning(
-            f"⚠️ ALLINEAMENTO: inviati {len(da_chiedere_gpt)} articoli, "
-            f"ricevuti {len(cat_by_idx)} idx validi, {mancanti} non mappati "
-            f"(→ Da Classificare, NESSUNO slittamento)"
-        )
+        salva_risposte([
+            {
+                "chiave": chiave_risposta(
+                    da_chiedere_normalizzate[v["idx"]],
+                    lista_fornitori[v["idx"]] if _ha_fornitori else None,
+                    lista_iva[v["idx"]] if _ha_iva else None,
+                    lista_hint[v["idx"]] if _ha_hint else None,
+                    _model,
+                ),
+                "categoria": v["categoria"],
+                "confidenza": confidenze_out[v["idx"]],
+                "token_stimati": _token_per_articolo,
+            }
+            for v in da_memorizzare
+        ], _model)
 
     if return_confidenze:
         return risultati, confidenze_out
@@ -4954,31 +5592,113 @@ def classifica_con_ai(
 
     # � Admin e impersonazione bypassano i limiti giornalieri AI per test operativi
     _is_unrestricted_admin = bool(st.session_state.get('user_is_admin', False) or st.session_state.get('impersonating', False))
+    _prenotazione = None
     if ristorante_id and not _is_unrestricted_admin:
         try:
-            from services.ai_cost_service import get_daily_quota_status
-
-            quota = get_daily_quota_status(
-                ristorante_id=ristorante_id,
-                operation_types=['categorization'],
-                daily_limit=MAX_AI_CALLS_PER_DAY,
+            from services import ai_quota
+            from services.gpt_dispatcher import dimensiona_batch
+
+            # Prenota PRIMA le chiamate del primo passaggio (stima per eccesso:
+            # la cache risposte puo' risparmiarne): due upload concorrenti non
+            # possono piu' passare entrambi il controllo e sforare insieme. Le
+            # chiamate non fatte tornano al lotto in conferma().
+            _prenotazione = ai_quota.riserva(
+                ristorante_id, 'categorization',
+                n=len(dimensiona_batch(lista_descrizioni, max_token_risposta=4096)),
+                limite=MAX_AI_CALLS_PER_DAY,
             )
-            _calls_today = int(quota['used'])
-            if quota['is_exceeded']:
+            if not _prenotazione.concessa:
                 logger.warning(
                     f"🔒 Rate limit categorizzazioni superato per ristorante {ristorante_id}: "
-                    f"{_calls_today}/{MAX_AI_CALLS_PER_DAY} chiamate oggi"
+                    f"{_prenotazione.usati}/{MAX_AI_CALLS_PER_DAY} chiamate oggi "
+                    f"(richieste {_prenotazione.n})"
                 )
                 raise AIDailyLimitExceededError(
-                    used=_calls_today,
+                    used=_prenotazione.usati,
                     limit=MAX_AI_CALLS_PER_DAY,
                     ristorante_id=ristorante_id,
                 )
         except RuntimeError:
             raise
         except Exception as _rl_err:
+            _prenotazione = None
             logger.warning(f"⚠️ Errore check rate limit AI: {_rl_err} — proseguo senza limite")
-    
+
+    _chiamate: List[int] = []
+    _ctx = _ai_ctx_chiamate_gpt.set(_chiamate)
+    try:
+        return _classifica_con_ai(
+            lista_descrizioni, lista_fornitori, lista_iva, lista_hint,
+            openai_client, ristorante_id, return_confidenze,
+        )
+    finally:
+        _ai_ctx_chiamate_gpt.reset(_ctx)
+        if _prenotazione is not None:
+            from services import ai_quota
+
+            ai_quota.conferma(_prenotazione, len(_chiamate))
+
+
+def _rifinisci_categoria_ai(
+    desc: str,
+    cat: Optional[str],
+    conf: Optional[str],
+    fornitore: Optional[str] = None,
+) -> Tuple[Optional[str], Optional[str], Optional[str]]:
+    """Post-elaborazione deterministica di UNA categoria restituita da GPT.
+
+    Ritorna (categoria, confidenza, tipo): tipo None = invariata, "fallback" =
+    "Da Classificare" recuperata, "override" = categoria GPT corretta.
+
+    1. SAFETY NET sui "Da Classificare": regole forti, poi dizionario, poi
+       fornitore mono-categoria verificato (solo whitelist, vedi
+       _FORNITORI_MONOCAT_SAFE: la regola-fornitore di categorizza_con_memoria
+       non e' raggiungibile da qui, e senza questo recupero una descrizione
+       generica di un fornitore mono-merce noto restava aperta).
+    2. VALIDAZIONE POST-AI (fix V0): le regole forti correggono anche gli errori
+       che GPT assegna "con sicurezza" (es. SALMONI...(BRAVO) → BEVANDE per il
+       brand), coerente con categorizza_con_memoria dove sono applicate
+       all'output del dizionario senza condizione "Da Classificare".
+
+    Lo usano _classifica_con_ai e il batch notturno (services/ai_batch_notturno):
+    stesse risposte GPT, stesse correzioni.
+    """
+    tipo: Optional[str] = None
+    if cat == "Da Classificare":
+        cat_strong, reason = applica_regole_categoria_forti(desc, "Da Classificare")
+        if cat_strong != "Da Classificare":
+            cat, conf, tipo = cat_strong, "alta", "fallback"  # regola forte → confidence alta
+            logger.info(f"🧭 REGOLA FORTE FALLBACK: '{desc[:40]}' → {cat_strong} [{reason}]")
+        else:
+            cat_dict = applica_correzioni_dizionario(desc, "Da Classificare")
+            if cat_dict != "Da Classificare":
+                cat, conf, tipo = cat_dict, "media", "fallback"  # dizionario → confidence media
+                logger.info(f"📖 DIZIONARIO FALLBACK: '{desc[:40]}' → {cat_dict}")
+            else:
+                cat_forn = _categoria_da_fornitore_monocat(fornitore)
+                if cat_forn:
+                    cat, conf, tipo = cat_forn, "alta", "fallback"
+                    logger.info(f"🏭 FORNITORE MONOCAT FALLBACK: '{desc[:40]}' → {cat_forn} (forn: {fornitore})")
+    if not cat or cat == "Da Classificare":
+        return cat, conf, tipo
+    cat_validata, motivo_override = applica_regole_categoria_forti(desc, cat)
+    if motivo_override and cat_validata != cat:
+        logger.info(f"🛡️ OVERRIDE POST-AI: '{desc[:40]}' {cat} → {cat_validata} [{motivo_override}]")
+        # La regola forte ha priorità deterministica → confidence alta
+        return cat_validata, "alta", tipo or "override"
+    return cat, conf, tipo
+
+
+def _classifica_con_ai(
+    lista_descrizioni: List[str],
+    lista_fornitori: Optional[List[str]],
+    lista_iva: Optional[List[int]],
+    lista_hint: Optional[List[Optional[str]]],
+    openai_client: Optional[OpenAI],
+    ristorante_id: Optional[str],
+    return_confidenze: bool,
+) -> Union[List[str], Tuple[List[str], List[str]]]:
+    """Corpo di classifica_con_ai, dopo la prenotazione della quota giornaliera."""
     # Usa client iniettato o crea nuovo
     if openai_client is None:
         openai_client = _get_openai_client()
@@ -5025,24 +5745,89 @@ def classifica_con_ai(
         return _out_cats
 
     try:
-        # 🧠 PRIMA CHIAMATA GPT (max_tokens=4096 per evitare troncamenti)
-        cats_prima, confs_prima = _chiama_gpt_classificazione(
-            da_chiedere_gpt, openai_client, max_tokens=4096,
-            lista_fornitori=_get_fornitori_aligned(da_chiedere_gpt),
-            lista_iva=_get_iva_aligned(da_chiedere_gpt),
-            lista_hint=_get_hint_aligned(da_chiedere_gpt),
-            return_confidenze=True,
-        )
+        # 🗄️ CACHE RISPOSTE CONDIVISA: stessa descrizione/fornitore/IVA gia' chiesta a
+        # GPT (anche da un altro ristorante) con questo prompt e questo modello →
+        # risposta riusata, niente chiamata. Regole forti e guardrail a valle si
+        # applicano comunque, come sulle risposte fresche.
+        from services.ai_risposte_cache import chiave_risposta, leggi_risposte, registra_esito
+
+        _model = _modello_classificazione()
+        _forn_al = _get_fornitori_aligned(da_chiedere_gpt)
+        _iva_al = _get_iva_aligned(da_chiedere_gpt)
+        _hint_al = _get_hint_aligned(da_chiedere_gpt)
+        _chiavi_cache = {
+            desc: chiave_risposta(
+                _descrizione_per_gpt(desc),
+                _forn_al[i] if _forn_al else None,
+                _iva_al[i] if _iva_al else None,
+                _hint_al[i] if _hint_al else None,
+                _model,
+            )
+            for i, desc in enumerate(da_chiedere_gpt)
+        }
+        _in_cache = leggi_risposte(_chiavi_cache.values())
+        _token_risparmiati = 0
+        da_inviare_gpt = []
+        for desc in da_chiedere_gpt:
+            trovata = _in_cache.get(_chiavi_cache[desc])
+            if trovata is None:
+                da_inviare_gpt.append(desc)
+                continue
+            risultati[desc], confidenze_risultati[desc], _token = trovata
+            _token_risparmiati += _token
+        _hit = len(da_chiedere_gpt) - len(da_inviare_gpt)
+        if _hit:
+            logger.info(
+                f"🗄️ Cache risposte AI: {_hit}/{len(da_chiedere_gpt)} descrizioni senza chiamata GPT "
+                f"(~{_token_risparmiati} token risparmiati)"
+            )
+            registra_esito(
+                ristorante_id or _resolve_ristorante_id(), _model,
+                _hit, len(da_inviare_gpt), _token_risparmiati,
+            )
 
-        for desc, cat, conf in zip(da_chiedere_gpt, cats_prima, confs_prima):
-            risultati[desc] = cat
-            confidenze_risultati[desc] = conf
+        # 🧠 PRIMA CHIAMATA GPT (max_tokens=4096 per evitare troncamenti).
+        # Liste lunghe (es. /api/classify con un upload intero) → batch
+        # dimensionati sulla stima token e inviati in parallelo entro i limiti
+        # RPM/TPM (services/gpt_dispatcher). Un batch fallito degrada solo le
+        # sue descrizioni, che passano ai retry; se falliscono TUTTI vale il
+        # fallback complessivo di sempre (except sotto).
+        from services.gpt_dispatcher import dimensiona_batch, esegui_in_parallelo
+
+        def _primo_passaggio(batch: List[str]):
+            return _chiama_gpt_classificazione(
+                batch, openai_client, max_tokens=4096,
+                lista_fornitori=_get_fornitori_aligned(batch),
+                lista_iva=_get_iva_aligned(batch),
+                lista_hint=_get_hint_aligned(batch),
+                return_confidenze=True,
+            )
+
+        _errori_batch: List[BaseException] = []
+        _batch_riusciti = 0
+        for batch, esito, errore in esegui_in_parallelo(
+            dimensiona_batch(da_inviare_gpt, max_token_risposta=4096), _primo_passaggio,
+        ):
+            if errore is not None:
+                logger.warning(f"⚠️ Batch GPT da {len(batch)} descrizioni fallito: {errore}")
+                _errori_batch.append(errore)
+                for desc in batch:
+                    risultati[desc] = "Da Classificare"
+                    confidenze_risultati[desc] = "bassa"
+                continue
+            _batch_riusciti += 1
+            cats_prima, confs_prima = esito
+            for desc, cat, conf in zip(batch, cats_prima, confs_prima):
+                risultati[desc] = cat
+                confidenze_risultati[desc] = conf
+        if _errori_batch and not _batch_riusciti:
+            raise _errori_batch[0]
         
         # 🔄 RETRY AUTOMATICO: Se ci sono "Da Classificare", ritenta con batch più piccoli
         MAX_RETRY = 2
         for retry_num in range(1, MAX_RETRY + 1):
             # Trova descrizioni ancora "Da Classificare"
-            da_ritentare = [d for d in da_chiedere_gpt if risultati.get(d) == "Da Classificare"]
+            da_ritentare = [d for d in da_inviare_gpt if risultati.get(d) == "Da Classificare"]
             
             if not da_ritentare:
                 break  # Tutto classificato!
@@ -5071,66 +5856,27 @@ def classifica_con_ai(
                 logger.warning(f"⚠️ Errore durante retry {retry_num}: {retry_err}")
                 # Continua con i risultati che abbiamo
         
-        # 🔧 SAFETY NET: Applica regole forti + dizionario ai "Da Classificare" residui
+        # 🔧 SAFETY NET + 🛡️ VALIDAZIONE POST-AI (vedi _rifinisci_categoria_ai):
+        # condivisi con il batch notturno, che riceve le stesse risposte GPT.
         _fallback_count = 0
-        for desc in da_chiedere_gpt:
-            if risultati.get(desc) == "Da Classificare":
-                # Try strong rules first (higher precision)
-                cat_strong, reason = applica_regole_categoria_forti(desc, "Da Classificare")
-                if cat_strong != "Da Classificare":
-                    risultati[desc] = cat_strong
-                    confidenze_risultati[desc] = "alta"  # regola forte → confidence alta
-                    _fallback_count += 1
-                    logger.info(f"🧭 REGOLA FORTE FALLBACK: '{desc[:40]}' → {cat_strong} [{reason}]")
-                    continue
-                # Then try dictionary corrections
-                cat_dict = applica_correzioni_dizionario(desc, "Da Classificare")
-                if cat_dict != "Da Classificare":
-                    risultati[desc] = cat_dict
-                    confidenze_risultati[desc] = "media"  # dizionario → confidence media
-                    _fallback_count += 1
-                    logger.info(f"📖 DIZIONARIO FALLBACK: '{desc[:40]}' → {cat_dict}")
-                    continue
-                # Then try supplier rule — ONLY for verified mono-category suppliers
-                # (whitelist). La regola-fornitore vive in categorizza_con_memoria
-                # (LIVELLO 5) e NON era raggiungibile da questo percorso: una riga
-                # con descrizione generica che la GPT non riconosce (es. Deliveroo
-                # "COMMISSION") restava Da Classificare pur avendo un fornitore
-                # mono-merce noto. Recupero SOLO da whitelist per non rubare righe a
-                # fornitori misti (vedi _FORNITORI_MONOCAT_SAFE).
-                _forn_row = None
-                if lista_fornitori and len(lista_fornitori) == len(lista_descrizioni):
-                    _forn_row = lista_fornitori[_idx_map[desc]]
-                cat_forn = _categoria_da_fornitore_monocat(_forn_row)
-                if cat_forn:
-                    risultati[desc] = cat_forn
-                    confidenze_risultati[desc] = "alta"  # fornitore mono-cat → confidence alta
-                    _fallback_count += 1
-                    logger.info(f"🏭 FORNITORE MONOCAT FALLBACK: '{desc[:40]}' → {cat_forn} (forn: {_forn_row})")
-        if _fallback_count > 0:
-            logger.info(f"🔧 SAFETY NET: {_fallback_count} descrizioni recuperate con regole forti/dizionario")
-
-        # 🛡️ VALIDAZIONE POST-AI (fix V0): le regole forti devono correggere anche
-        # gli errori grossolani che la GPT assegna "con sicurezza" (categoria valida ma
-        # sbagliata), non solo i "Da Classificare" residui. Senza questo, una risposta
-        # GPT errata (es. SALMONI...(BRAVO) → BEVANDE per il brand) passava intatta,
-        # bypassando le ~250 regole deterministiche pensate proprio per evitarlo.
-        # Coerente con la fase A (categorizza_con_memoria), dove applica_regole_categoria_forti
-        # è già applicata all'output del dizionario senza condizione "Da Classificare".
         _override_count = 0
         for desc in da_chiedere_gpt:
-            cat_corrente = risultati.get(desc)
-            if not cat_corrente or cat_corrente == "Da Classificare":
-                continue  # già gestito dal safety net sopra
-            cat_validata, motivo_override = applica_regole_categoria_forti(desc, cat_corrente)
-            if motivo_override and cat_validata != cat_corrente:
-                risultati[desc] = cat_validata
-                # La regola forte ha priorità deterministica → confidence alta
-                confidenze_risultati[desc] = "alta"
+            _forn_row = None
+            if lista_fornitori and len(lista_fornitori) == len(lista_descrizioni):
+                _forn_row = lista_fornitori[_idx_map[desc]]
+            cat_fin, conf_fin, tipo = _rifinisci_categoria_ai(
+                desc, risultati.get(desc), confidenze_risultati.get(desc), _forn_row,
+            )
+            if tipo is None:
+                continue
+            risultati[desc] = cat_fin
+            confidenze_risultati[desc] = conf_fin
+            if tipo == "fallback":
+                _fallback_count += 1
+            else:
                 _override_count += 1
-                logger.info(
-                    f"🛡️ OVERRIDE POST-AI: '{desc[:40]}' {cat_corrente} → {cat_validata} [{motivo_override}]"
-                )
+        if _fallback_count > 0:
+            logger.info(f"🔧 SAFETY NET: {_fallback_count} descrizioni recuperate con regole forti/dizionario")
         if _override_count > 0:
             logger.info(f"🛡️ VALIDAZIONE POST-AI: {_override_count} categorie GPT corrette da regole forti")
         
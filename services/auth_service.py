@@ -30,6 +30,7 @@ from collections import defaultdict
 
 # Logger centralizzato
 from config.logger_setup import get_logger
+from utils.ttl_cache import TTLCache
 logger = get_logger('auth')
 
 # Hasher globale Argon2
@@ -1113,17 +1114,17 @@ def riepilogo_fatture_auto_da_ultimo_login(
         return riepilogo
 
 
-# Cache validazione sessione: {token: (expires_at, user_dict_or_None)}. TTL breve.
-_SESSIONE_CACHE: Dict[str, tuple] = {}
+# Cache validazione sessione: {token: user_dict}. TTL breve.
+# LRU limitata (utils/ttl_cache): keyed per token (uno per login/dispositivo), da
+# dict semplice cresceva per tutta la vita del processo. Con i token di accesso
+# firmati (services/session_token) qui passano solo le richieste col token di sessione.
 _SESSIONE_CACHE_TTL = 30.0  # secondi
+_SESSIONE_CACHE = TTLCache(ttl=_SESSIONE_CACHE_TTL, nome="sessione", max_entries=5000)
 
 
 def _clear_sessione_cache(token: Optional[str] = None) -> None:
     """Invalida la cache sessione (un token, o tutta su logout)."""
-    if token is None:
-        _SESSIONE_CACHE.clear()
-    else:
-        _SESSIONE_CACHE.pop(token, None)
+    _SESSIONE_CACHE.invalidate(token)
 
 
 def verifica_sessione_da_cookie(
@@ -1153,15 +1154,20 @@ def verifica_sessione_da_cookie(
         if not token:
             return None
 
+        # Token di accesso firmato (services/session_token): verifica locale,
+        # niente cache ne' query. Se non e' valido non si ripiega sui path
+        # sotto: il client ripete con il token di sessione.
+        from services import session_token
+        if session_token.e_token_accesso(token):
+            return session_token.verifica(token)
+
         # Cache TTL breve: una pagina chiama 6 endpoint in parallelo, ognuno
         # validava la sessione con una query DB. TTL 30s -> al massimo 30s di
         # ritardo dopo un logout (che comunque svuota la cache via _clear_sessione_cache).
-        import time as _t
         _ck = token
-        _now = _t.time()
         _cached = _SESSIONE_CACHE.get(_ck)
-        if _cached is not None and _cached[0] > _now:
-            return dict(_cached[1]) if _cached[1] is not None else None
+        if _cached is not None:
+            return dict(_cached)
 
         if supabase_client is None:
             supabase_client = get_supabase_client()
@@ -1247,7 +1253,7 @@ def verifica_sessione_da_cookie(
                 for _sk in ('password_hash', 'reset_code', 'reset_expires', 'session_token'):
                     _u.pop(_sk, None)
                 tocca_sessione(token, supabase_client=supabase_client)
-                _SESSIONE_CACHE[_ck] = (_now + _SESSIONE_CACHE_TTL, dict(_u))
+                _SESSIONE_CACHE.set(_ck, dict(_u))
                 return _u
             # utente disattivato/eliminato: la sessione non vale più
             return None
@@ -1325,7 +1331,7 @@ def verifica_sessione_da_cookie(
         for _sensitive_key in ('password_hash', 'reset_code', 'reset_expires'):
             user.pop(_sensitive_key, None)
 
-        _SESSIONE_CACHE[_ck] = (_now + _SESSIONE_CACHE_TTL, dict(user))
+        _SESSIONE_CACHE.set(_ck, dict(user))
         return user
 
     except Exception as e:
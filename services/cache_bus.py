@@ -0,0 +1,274 @@
+"""Bus di invalidazione delle cache in-process tra processi (tabella cache_eventi).
+
+Problema: _invalidate_fatture_rows_cache, _invalidate_home_kpi_cache e
+l'invalidazione della memoria classificazione puliscono solo la cache del
+processo che ha servito la scrittura. Con WORKER_WEB_CONCURRENCY>1, e con il
+queue-worker (processo Railway separato) che salva le fatture, gli altri
+processi servivano dati stantii fino allo scadere del TTL. Per questo i TTL
+restavano corti (15s sulle righe), anche se le stesse righe si rileggono per
+minuti.
+
+Qui ogni invalidazione locale pubblica anche un evento `(dominio,
+ristorante_id)` su public.cache_eventi. Ogni processo legge gli eventi nuovi
+(id > ultimo visto) ogni ONEFLUX_CACHE_BUS_POLL_S secondi (default 2) e
+applica gli handler registrati per il dominio: solo le chiavi di quel
+ristorante, mai l'intera cache. Gli eventi emessi dallo stesso processo si
+saltano (l'invalidazione locale e' gia' avvenuta).
+
+Gli id (bigserial) si assegnano all'insert ma diventano visibili al commit:
+due processi che pubblicano insieme possono rendere visibile prima l'id 11
+e poi il 10. Un cursore `id > ultimo` salterebbe il 10 per sempre. Per questo
+ogni giro rilegge anche gli ultimi _FINESTRA id sotto il cursore e salta
+quelli gia' applicati (insieme `_visti`, limitato alla stessa finestra).
+
+Niente LISTEN/NOTIFY: il worker parla con Postgres solo via PostgREST, senza
+una connessione diretta su cui restare in ascolto. Il polling e' una SELECT
+sulla chiave primaria, che a bus fermo torna vuota.
+
+La pubblicazione non fa I/O sul percorso della richiesta. Accoda l'evento
+(gli eventi uguali si fondono) e sveglia il thread del bus, che lo scrive
+subito. Un processo che non ha avviato il bus (script, test) non pubblica
+niente. Gli eventi piu' vecchi di un giorno si cancellano: servono solo ai
+processi che li devono ancora leggere.
+"""
+
+from __future__ import annotations
+
+import os
+import threading
+import time
+import uuid
+from collections import defaultdict
+from datetime import datetime, timedelta, timezone
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple
+
+from config.logger_setup import get_logger
+
+logger = get_logger('cache_bus')
+
+TABELLA = "cache_eventi"
+
+# Identifica gli eventi emessi da questo processo (saltati in lettura).
+ORIGINE = uuid.uuid4().hex
+
+# Righe lette per SELECT: un burst piu' grande si smaltisce in piu' giri.
+_LOTTO = 500
+# Id sotto il cursore riletti a ogni giro, per gli eventi committati fuori
+# ordine. Deve restare sotto _LOTTO, o un lotto pieno di id gia' visti non
+# farebbe avanzare il cursore.
+_FINESTRA = 100
+# Oltre, gli eventi non ancora scritti si scartano (DB irraggiungibile): resta
+# il TTL delle cache come rete di sicurezza.
+_MAX_PENDENTI = 5000
+_RETENTION = timedelta(days=1)
+_PULIZIA_OGNI_S = 3600.0
+
+Handler = Callable[[Optional[str]], None]
+
+_handlers: Dict[str, List[Handler]] = defaultdict(list)
+_pendenti: Set[Tuple[str, Optional[str]]] = set()
+# Id gia' letti nella finestra sotto il cursore (solo il thread del bus li tocca).
+_visti: Set[int] = set()
+_lock = threading.Lock()
+_sveglia = threading.Event()
+_thread: Optional[threading.Thread] = None
+_stato: Dict[str, Any] = {
+    "ultimo_id": None,
+    "pubblicati": 0,
+    "ricevuti": 0,
+    "applicati": 0,
+    "scartati": 0,
+    "errori": 0,
+    "ultima_pulizia": 0.0,
+}
+
+
+def intervallo_poll() -> float:
+    try:
+        return max(0.0, float(os.getenv("ONEFLUX_CACHE_BUS_POLL_S", "2")))
+    except ValueError:
+        return 2.0
+
+
+def registra(dominio: str, handler: Handler) -> None:
+    """Handler(ristorante_id | None) chiamato sugli eventi di `dominio` degli altri processi."""
+    with _lock:
+        if handler not in _handlers[dominio]:
+            _handlers[dominio].append(handler)
+
+
+def attivo() -> bool:
+    return _thread is not None and _thread.is_alive()
+
+
+def pubblica(dominio: str, ristorante_id: Optional[str] = None) -> None:
+    """Notifica agli altri processi che `dominio` (di un ristorante, o tutto) e' cambiato."""
+    if not attivo():
+        return
+    evento = (dominio, str(ristorante_id) if ristorante_id is not None else None)
+    with _lock:
+        if len(_pendenti) >= _MAX_PENDENTI and evento not in _pendenti:
+            _stato["scartati"] += 1
+            return
+        _pendenti.add(evento)
+    _sveglia.set()
+
+
+def _get_client(supabase_client):
+    if supabase_client is not None:
+        return supabase_client
+    from services import get_supabase_client
+    return get_supabase_client()
+
+
+def invia_pendenti(supabase_client=None) -> int:
+    """Scrive gli eventi accodati; ritorna quanti (-1 su errore, eventi rimessi in coda)."""
+    with _lock:
+        eventi = list(_pendenti)
+        _pendenti.clear()
+    if not eventi:
+        return 0
+    righe = [{"dominio": d, "ristorante_id": r, "origine": ORIGINE} for d, r in eventi]
+    try:
+        _get_client(supabase_client).table(TABELLA).insert(righe).execute()
+    except Exception as exc:
+        _stato["errori"] += 1
+        logger.warning("cache_bus: pubblicazione di %d eventi fallita (%s)", len(righe), exc)
+        with _lock:
+            for ev in eventi:
+                if len(_pendenti) < _MAX_PENDENTI:
+                    _pendenti.add(ev)
+                else:
+                    _stato["scartati"] += 1
+        return -1
+    _stato["pubblicati"] += len(righe)
+    return len(righe)
+
+
+def applica(eventi: List[Dict[str, Any]]) -> int:
+    """Chiama gli handler sugli eventi di altri processi; ritorna quanti applicati."""
+    applicati = 0
+    for ev in eventi:
+        if ev.get("origine") == ORIGINE:
+            continue
+        with _lock:
+            handlers = list(_handlers.get(str(ev.get("dominio") or ""), ()))
+        rid = ev.get("ristorante_id")
+        for handler in handlers:
+            try:
+                handler(str(rid) if rid is not None else None)
+            except Exception as exc:
+                logger.warning("cache_bus: handler %s fallito (%s)", ev.get("dominio"), exc)
+        applicati += 1
+    _stato["applicati"] += applicati
+    return applicati
+
+
+def sincronizza(supabase_client=None) -> int:
+    """Legge e applica gli eventi nuovi; ritorna le righe lette (-1 su errore).
+
+    Alla prima chiamata parte dall'ultimo id esistente: gli eventi precedenti
+    riguardano cache che questo processo non aveva ancora. La lettura riparte
+    _FINESTRA id sotto il cursore; gli id gia' visti non si riapplicano.
+    """
+    try:
+        sb = _get_client(supabase_client)
+        if _stato["ultimo_id"] is None:
+            resp = sb.table(TABELLA).select("id").order("id", desc=True).limit(_FINESTRA).execute()
+            righe = resp.data if isinstance(resp.data, list) else []
+            _visti.update(int(r["id"]) for r in righe)
+            _stato["ultimo_id"] = max(_visti, default=0)
+            return 0
+        lette = 0
+        da = _stato["ultimo_id"] - _FINESTRA
+        while True:
+            resp = (
+                sb.table(TABELLA)
+                .select("id, dominio, ristorante_id, origine")
+                .gt("id", da)
+                .order("id")
+                .limit(_LOTTO)
+                .execute()
+            )
+            righe = resp.data if isinstance(resp.data, list) else []
+            if not righe:
+                break
+            da = max(int(r["id"]) for r in righe)
+            nuove = [r for r in righe if int(r["id"]) not in _visti]
+            _visti.update(int(r["id"]) for r in nuove)
+            _stato["ultimo_id"] = max(_stato["ultimo_id"], da)
+            _stato["ricevuti"] += len(nuove)
+            lette += len(nuove)
+            applica(nuove)
+            if len(righe) < _LOTTO:
+                break
+        soglia = _stato["ultimo_id"] - _FINESTRA
+        _visti.difference_update([i for i in _visti if i <= soglia])
+        return lette
+    except Exception as exc:
+        _stato["errori"] += 1
+        logger.warning("cache_bus: lettura eventi fallita (%s)", exc)
+        return -1
+
+
+def pulisci_vecchi(supabase_client=None) -> None:
+    _stato["ultima_pulizia"] = time.monotonic()
+    soglia = (datetime.now(timezone.utc) - _RETENTION).strftime("%Y-%m-%dT%H:%M:%SZ")
+    try:
+        _get_client(supabase_client).table(TABELLA).delete().lt("created_at", soglia).execute()
+    except Exception as exc:
+        logger.warning("cache_bus: pulizia eventi fallita (%s)", exc)
+
+
+def _ciclo(intervallo: float) -> None:
+    while True:
+        _sveglia.wait(intervallo)
+        _sveglia.clear()
+        invia_pendenti()
+        sincronizza()
+        if time.monotonic() - _stato["ultima_pulizia"] >= _PULIZIA_OGNI_S:
+            pulisci_vecchi()
+
+
+def avvia(intervallo: Optional[float] = None) -> bool:
+    """Avvia (una volta per processo) il thread del bus; False se disattivato (intervallo 0)."""
+    global _thread
+    intervallo = intervallo_poll() if intervallo is None else intervallo
+    if intervallo <= 0:
+        logger.info("cache_bus disattivato (ONEFLUX_CACHE_BUS_POLL_S=0)")
+        return False
+    with _lock:
+        if attivo():
+            return True
+        # La prima pulizia aspetta un intervallo pieno: al deploy partono tutti insieme.
+        _stato["ultima_pulizia"] = time.monotonic()
+        _thread = threading.Thread(target=_ciclo, args=(intervallo,), name="cache-bus", daemon=True)
+        _thread.start()
+    logger.info("cache_bus avviato (poll %.1fs, origine %s)", intervallo, ORIGINE[:8])
+    return True
+
+
+def stato() -> Dict[str, Any]:
+    with _lock:
+        pendenti = len(_pendenti)
+        domini = sorted(_handlers)
+    return {
+        "attivo": attivo(),
+        "poll_s": intervallo_poll(),
+        "domini": domini,
+        "pendenti": pendenti,
+        "ultimo_id": _stato["ultimo_id"],
+        "pubblicati": _stato["pubblicati"],
+        "ricevuti": _stato["ricevuti"],
+        "applicati": _stato["applicati"],
+        "scartati": _stato["scartati"],
+        "errori": _stato["errori"],
+    }
+
+
+def reset() -> None:
+    """Svuota coda e contatori (test). Handler e thread restano."""
+    with _lock:
+        _pendenti.clear()
+    _visti.clear()
+    _stato.update(ultimo_id=None, pubblicati=0, ricevuti=0, applicati=0, scartati=0, errori=0)
@@ -0,0 +1,314 @@
+"""Cubo dei costi mensili per (ristorante, mese, categoria, fornitore): lettura e coerenza.
+
+La tabella public.costi_mensili_cubo ha una riga per cella (ristorante, user,
+mese di competenza, mese documento, categoria, fornitore, fonte) con totale,
+totale delle sole righe positive e numero di righe. La mantiene il DB: trigger
+per statement su `fatture` applicano il delta delle righe scritte, trigger su
+riparto_costi_catena_quote ricalcolano le quote di gruppo del PV (vedi
+migration 20261005100000_costi_mensili_cubo.sql). Nessun chiamante Python deve
+aggiornarla.
+
+Qui ci sono solo:
+- `leggi_mensile`: celle per (ristorante, anno, mese, categoria, fonte) su base
+  competenza o documento, in una chiamata (RPC costi_cubo_mensili);
+- `costi_automatici` / `per_categoria`: le due letture dei margini (F&B e spese
+  del MOL, costo per categoria dei centri di produzione);
+- `leggi_celle_async` / `riepilogo_dashboard`: le celle per fornitore della
+  dashboard Home;
+- `ricostruisci`: rebuild da zero via RPC (scripts/costi_cubo.py);
+- `celle_da_righe` / `verifica_coerenza`: le stesse celle calcolate in Python
+  dalle righe grezze e il confronto con la tabella.
+
+Le letture sollevano se il cubo non risponde con una lista: i chiamanti
+ricadono sul calcolo dalle righe, come per le altre RPC di aggregazione.
+"""
+
+from __future__ import annotations
+
+import math
+from collections import defaultdict
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple
+
+from config.constants import CATEGORIA_NON_CLASSIFICATA
+from config.logger_setup import get_logger
+from utils.supabase_paging import fetch_all, fetch_all_async
+
+logger = get_logger('costi_cubo')
+
+TABELLA = "costi_mensili_cubo"
+
+BASE_COMPETENZA = "competenza"  # COALESCE(data_competenza, data_documento)
+BASE_DOCUMENTO = "documento"    # data_documento
+
+FONTE_FATTURA = "fattura"       # righe della sede
+FONTE_RIPARTITA = "ripartita"   # righe con ripartita_su_gruppo (fuori dal MOL)
+FONTE_QUOTA = "quota"           # quote dei costi di gruppo a carico del PV
+
+# Categoria vuota (NULL sulla riga) o ancora da classificare: fuori dai margini.
+_NON_CLASSIFICATE = frozenset({"", CATEGORIA_NON_CLASSIFICATA})
+
+_CHIAVE_CELLA = ("anno", "mese", "anno_doc", "mese_doc", "categoria", "fornitore", "fonte", "user_id")
+
+Mese = Tuple[str, int, int]  # (ristorante_id, anno, mese)
+
+
+def _get_client(supabase_client):
+    if supabase_client is not None:
+        return supabase_client
+    from services import get_supabase_client
+    return get_supabase_client()
+
+
+def leggi_mensile(
+    ristorante_ids: Sequence[str],
+    anno_da: Optional[int] = None,
+    anno_a: Optional[int] = None,
+    *,
+    base: str = BASE_COMPETENZA,
+    user_id: Optional[str] = None,
+    supabase_client=None,
+) -> List[Dict[str, Any]]:
+    """Celle del cubo per (ristorante, anno, mese, categoria, fonte), fornitori sommati.
+
+    Anni None = nessun limite; le righe senza data hanno anno e mese 0.
+    """
+    resp = _get_client(supabase_client).rpc(
+        "costi_cubo_mensili",
+        {
+            "p_ristorante_ids": [str(r) for r in ristorante_ids],
+            "p_anno_da": anno_da,
+            "p_anno_a": anno_a,
+            "p_base": base,
+            "p_user_id": user_id,
+        },
+    ).execute()
+    righe = resp.data
+    if not isinstance(righe, list):
+        raise RuntimeError(f"costi_cubo_mensili: risposta inattesa ({type(righe).__name__})")
+    return righe
+
+
+def costi_automatici(
+    righe: Iterable[Dict[str, Any]],
+    *,
+    spese: Iterable[str],
+    escluse: Iterable[str] = (),
+) -> Dict[Mese, Tuple[float, float]]:
+    """Costi F&B e spese generali del MOL: {(ristorante_id, anno, mese): (fb, spese)}.
+
+    Stesse regole degli aggregatori sulle righe: solo righe della sede (niente
+    quote ne' righe ripartite, che il MOL somma a parte), niente categorie
+    vuote o da classificare; spese se la categoria e' in `spese`, altrimenti F&B
+    se non e' in `escluse` (note e diciture). Importi con segno, non arrotondati.
+    """
+    spese_set, escluse_set = set(spese), set(escluse)
+    acc: Dict[Mese, List[float]] = defaultdict(lambda: [0.0, 0.0])
+    for r in righe:
+        cat = r.get("categoria") or ""
+        if r.get("fonte") != FONTE_FATTURA or cat in _NON_CLASSIFICATE:
+            continue
+        if cat in spese_set:
+            idx = 1
+        elif cat not in escluse_set:
+            idx = 0
+        else:
+            continue
+        acc[(str(r["ristorante_id"]), int(r["anno"]), int(r["mese"]))][idx] += float(r.get("totale") or 0)
+    return {k: (v[0], v[1]) for k, v in acc.items()}
+
+
+def per_categoria(
+    righe: Iterable[Dict[str, Any]],
+    categorie: Iterable[str],
+    *,
+    fonti: Iterable[str] = (FONTE_FATTURA, FONTE_QUOTA),
+) -> Dict[Tuple[str, int, int, str], float]:
+    """Costo delle righe positive per {(ristorante_id, anno, mese, categoria)}.
+
+    E' la lettura dei centri di produzione: righe della sede piu' le quote di
+    gruppo del PV, solo le `categorie` indicate, storni esclusi.
+    """
+    cat_set, fonti_set = set(categorie), set(fonti)
+    out: Dict[Tuple[str, int, int, str], float] = defaultdict(float)
+    for r in righe:
+        cat = r.get("categoria") or ""
+        if r.get("fonte") not in fonti_set or cat not in cat_set:
+            continue
+        valore = float(r.get("totale_positivo") or 0)
+        if valore > 0:
+            out[(str(r["ristorante_id"]), int(r["anno"]), int(r["mese"]), cat)] += valore
+    return dict(out)
+
+
+async def leggi_celle_async(asb, ristorante_id: str, user_id: Optional[str] = None) -> List[Dict[str, Any]]:
+    """Celle della sede per mese documento e fornitore (client async, a pagine)."""
+    q = (
+        asb.table(TABELLA)
+        .select("anno_doc,mese_doc,categoria,fornitore,fonte,totale,n_righe")
+        .eq("ristorante_id", ristorante_id)
+    )
+    if user_id:
+        q = q.eq("user_id", user_id)
+    for col in _CHIAVE_CELLA:
+        q = q.order(col)
+    return await fetch_all_async(q)
+
+
+def riepilogo_dashboard(
+    celle: Iterable[Dict[str, Any]],
+    mese_corrente: str,
+    mese_precedente: str,
+    *,
+    top: int = 5,
+    ultimi_mesi: int = 12,
+) -> Dict[str, Any]:
+    """Totali della dashboard Home dalle celle per fornitore (righe fattura, quote escluse).
+
+    Stesse regole del calcolo sulle righe: fornitore e categoria con trim e
+    '—' se vuoti, mesi per data documento ('YYYY-MM'), ultimi `ultimi_mesi`.
+    """
+    spesa_totale = 0.0
+    righe_totali = 0
+    per_mese: Dict[str, float] = defaultdict(float)
+    per_fornitore: Dict[str, List[float]] = defaultdict(lambda: [0.0, 0])
+    per_categoria_: Dict[str, List[float]] = defaultdict(lambda: [0.0, 0])
+    for c in celle:
+        if c.get("fonte") == FONTE_QUOTA:
+            continue
+        totale = float(c.get("totale") or 0)
+        n = int(c.get("n_righe") or 0)
+        spesa_totale += totale
+        righe_totali += n
+        anno, mese = int(c.get("anno_doc") or 0), int(c.get("mese_doc") or 0)
+        if anno:
+            per_mese[f"{anno:04d}-{mese:02d}"] += totale
+        for acc, valore in ((per_fornitore, c.get("fornitore")), (per_categoria_, c.get("categoria"))):
+            voce = acc[(valore or "").strip() or "—"]
+            voce[0] += totale
+            voce[1] += n
+
+    def _top(acc):
+        ordinate = sorted(acc.items(), key=lambda x: x[1][0], reverse=True)[:top]
+        return [(nome, spesa, int(n)) for nome, (spesa, n) in ordinate]
+
+    return {
+        "spesa_totale": spesa_totale,
+        "righe_totali": righe_totali,
+        "spesa_mese_corrente": per_mese.get(mese_corrente, 0.0),
+        "spesa_mese_precedente": per_mese.get(mese_precedente, 0.0),
+        "spesa_mensile": sorted(per_mese.items())[-ultimi_mesi:],
+        "top_fornitori": _top(per_fornitore),
+        "top_categorie": _top(per_categoria_),
+    }
+
+
+def ricostruisci(ristorante_id: Optional[str] = None, supabase_client=None) -> int:
+    """Ricalcola da zero il cubo di una sede (o di tutte con None); ritorna le celle scritte."""
+    resp = _get_client(supabase_client).rpc(
+        "costi_cubo_ricostruisci", {"p_ristorante_id": ristorante_id}
+    ).execute()
+    n = int(resp.data or 0)
+    logger.info("costi_cubo: ricostruite %d celle (ristorante %s)", n, ristorante_id or "tutti")
+    return n
+
+
+def _anno_mese(data: Any) -> Tuple[int, int]:
+    s = str(data or "")
+    try:
+        return int(s[:4]), int(s[5:7])
+    except ValueError:
+        return 0, 0
+
+
+def celle_da_righe(righe: Iterable[Dict[str, Any]]) -> Dict[Tuple, Dict[str, float]]:
+    """Celle attese dalle righe grezze di `fatture` (stesse regole del trigger).
+
+    Le righe servono con user_id, data_documento, data_competenza, categoria,
+    fornitore, totale_riga e ripartita_su_gruppo; quelle cancellate vanno gia'
+    escluse. Chiave nell'ordine di `_CHIAVE_CELLA`.
+    """
+    out: Dict[Tuple, Dict[str, float]] = {}
+    for r in righe:
+        totale = float(r.get("totale_riga") or 0)
+        chiave = (
+            *_anno_mese(r.get("data_competenza") or r.get("data_documento")),
+            *_anno_mese(r.get("data_documento")),
+            r.get("categoria") or "",
+            r.get("fornitore") or "",
+            FONTE_RIPARTITA if r.get("ripartita_su_gruppo") else FONTE_FATTURA,
+            str(r.get("user_id")),
+        )
+        cella = out.setdefault(chiave, {"totale": 0.0, "totale_positivo": 0.0, "n_righe": 0})
+        cella["totale"] += totale
+        cella["totale_positivo"] += max(totale, 0.0)
+        cella["n_righe"] += 1
+    return out
+
+
+def _chiave_tabella(r: Dict[str, Any]) -> Tuple:
+    return (
+        int(r["anno"]), int(r["mese"]), int(r["anno_doc"]), int(r["mese_doc"]),
+        r.get("categoria") or "", r.get("fornitore") or "", r.get("fonte"), str(r.get("user_id")),
+    )
+
+
+def confronta(
+    attese: Dict[Tuple, Dict[str, float]],
+    tabella: Iterable[Dict[str, Any]],
+    *,
+    max_esempi: int = 20,
+) -> Dict[str, Any]:
+    """Differenze tra le celle attese e quelle del cubo (importi al centesimo)."""
+    presenti = {_chiave_tabella(r): r for r in tabella}
+    mancanti = sorted(set(attese) - set(presenti))
+    in_eccesso = sorted(set(presenti) - set(attese))
+    diverse: List[Dict[str, Any]] = []
+    for k in sorted(set(attese) & set(presenti)):
+        campi = [
+            c for c, v in attese[k].items()
+            if not math.isclose(float(v), float(presenti[k].get(c) or 0), abs_tol=0.005)
+        ]
+        if campi:
+            diverse.append({"chiave": list(k), "campi": campi})
+    return {
+        "coerente": not (mancanti or in_eccesso or diverse),
+        "celle_attese": len(attese),
+        "celle_tabella": len(presenti),
+        "mancanti": [list(k) for k in mancanti[:max_esempi]],
+        "n_mancanti": len(mancanti),
+        "in_eccesso": [list(k) for k in in_eccesso[:max_esempi]],
+        "n_in_eccesso": len(in_eccesso),
+        "diverse": diverse[:max_esempi],
+        "n_diverse": len(diverse),
+    }
+
+
+def verifica_coerenza(ristorante_id: str, supabase_client=None) -> Dict[str, Any]:
+    """Ricalcola le celle fattura della sede dalle righe grezze e le confronta col cubo.
+
+    Le celle 'quota' restano fuori: dipendono solo da riparto_costi_catena_quote
+    e si ricalcolano per intero a ogni scrittura.
+    """
+    sb = _get_client(supabase_client)
+    righe = fetch_all(
+        sb.table("fatture")
+        .select("id,user_id,data_documento,data_competenza,categoria,fornitore,totale_riga,ripartita_su_gruppo")
+        .eq("ristorante_id", ristorante_id)
+        .is_("deleted_at", "null")
+        .order("id")
+    )
+    tabella = fetch_all(
+        sb.table(TABELLA)
+        .select(",".join(_CHIAVE_CELLA) + ",totale,totale_positivo,n_righe")
+        .eq("ristorante_id", ristorante_id)
+        .neq("fonte", FONTE_QUOTA)
+        .order("anno").order("mese").order("anno_doc").order("mese_doc")
+        .order("categoria").order("fornitore").order("fonte").order("user_id")
+    )
+    esito = confronta(celle_da_righe(righe), tabella)
+    if not esito["coerente"]:
+        logger.warning(
+            "costi_mensili_cubo incoerente per %s: %d mancanti, %d in eccesso, %d diverse",
+            ristorante_id, esito["n_mancanti"], esito["n_in_eccesso"], esito["n_diverse"],
+        )
+    return esito
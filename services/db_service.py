@@ -467,121 +467,66 @@ def calcola_alert(df: pd.DataFrame, soglia_minima: float, filtro_prodotto: str =
     if filtro_prodotto:
         df_fb = df_fb[df_fb['Descrizione'].str.contains(filtro_prodotto, case=False, na=False, regex=False)]
 
-    df = df_fb  # Usa solo prodotti F&B
+    # Motore vettoriale condiviso con /api/prezzi/variazioni
+    # (services/variazioni_prezzi): ordinamento unico e metriche a segmenti,
+    # stringhe solo per i gruppi oltre soglia. Qui la lettura "recente":
+    # media degli ultimi 5 prezzi, quantita' delle ultime 3, frequenza dagli
+    # intervalli tra gli ultimi 4 acquisti.
+    from services import variazioni_prezzi
 
-    if df.empty:
+    if df_fb.empty:
         return pd.DataFrame(columns=_ALERT_COLUMNS)
-
-    alert_list = []
-
-    # Normalizza chiavi groupby (case-insensitive, strip spazi)
-    df = df.copy()
-    df['_desc_key'] = df['Descrizione'].astype(str).str.strip().str.upper()
-    df['_forn_key'] = df['Fornitore'].astype(str).str.strip().str.upper()
-
-    # Raggruppa per Descrizione + Fornitore (case-insensitive)
-    for (_dk, _fk), group in df.groupby(['_desc_key', '_forn_key']):
-        prodotto = group['Descrizione'].mode()[0]
-        fornitore = group['Fornitore'].mode()[0]
-        group = group.sort_values('DataDocumento')
-
-        acquisti_validi = group[group['PrezzoUnitario'] > 0].copy()
-
-        if len(acquisti_validi) < 2:
-            continue
-
-        ultimo = acquisti_validi.iloc[-1]
-        penultimo = acquisti_validi.iloc[-2]
-
-        prezzo_ultimo = float(ultimo['PrezzoUnitario'])
-        prezzo_penultimo = float(penultimo['PrezzoUnitario'])
-        delta_euro = prezzo_ultimo - prezzo_penultimo
-
-        nota_stagionale = ""
-        try:
-            data_penultimo = pd.to_datetime(penultimo['DataDocumento'], utc=True)
-            data_ultimo = pd.to_datetime(ultimo['DataDocumento'], utc=True)
-            giorni_diff = (data_ultimo - data_penultimo).days
-
-            if giorni_diff > 180:
-                nota_stagionale = " ⚠️ >6m"
-        except (ValueError, TypeError):
-            pass
-
-        variazione_perc = ((prezzo_ultimo - prezzo_penultimo) / prezzo_penultimo) * 100
-
-        if abs(variazione_perc) >= soglia_minima:
-            file_origine = str(ultimo.get('FileOrigine', ''))
-            numero_documento = str(ultimo.get('NumeroDocumento', '') or '')
-            n_acquisti = len(acquisti_validi)
-
-            if n_acquisti >= 2:
-                ultimi_cinque = acquisti_validi.tail(5)
-                prezzi_storici = [f"€{p:.2f}" for p in ultimi_cinque['PrezzoUnitario'].tolist()]
-                storico_str = " → ".join(prezzi_storici)
-                media_storico = float(ultimi_cinque['PrezzoUnitario'].mean())
-            else:
-                storico_str = "-"
-                media_storico = prezzo_penultimo
-
-            # Trend sintetico sulle ultime variazioni
-            prezzi_recenti = pd.to_numeric(acquisti_validi['PrezzoUnitario'].tail(4), errors='coerce').dropna().tolist()
-            variazioni_recenti = [
-                prezzi_recenti[i] - prezzi_recenti[i - 1]
-                for i in range(1, len(prezzi_recenti))
-                if abs(prezzi_recenti[i] - prezzi_recenti[i - 1]) > 0.0001
-            ]
-            if len(variazioni_recenti) >= 3 and all(v > 0 for v in variazioni_recenti[-3:]):
-                trend = '⬆️⬆️'
-            elif len(variazioni_recenti) >= 3 and all(v < 0 for v in variazioni_recenti[-3:]):
-                trend = '⬇️⬇️'
-            elif any(v > 0 for v in variazioni_recenti) and any(v < 0 for v in variazioni_recenti):
-                trend = '↕️'
-            elif delta_euro > 0:
-                trend = '⬆️'
-            elif delta_euro < 0:
-                trend = '⬇️'
-            else:
-                trend = '↕️'
-
-            # Impatto economico stimato: delta ultimo vs penultimo × q.tà media recente × frequenza acquisto stimata
-            if 'Quantita' in acquisti_validi.columns:
-                quantita_recenti = pd.to_numeric(acquisti_validi['Quantita'].tail(3), errors='coerce').dropna()
-            else:
-                quantita_recenti = pd.Series(dtype=float)
-            quantita_riferimento = float(quantita_recenti.mean()) if not quantita_recenti.empty else 1.0
-
-            date_recenti = pd.to_datetime(acquisti_validi['DataDocumento'].tail(4), errors='coerce').dropna().sort_values()
-            frequenza_mensile = 1.0
-            if len(date_recenti) >= 2:
-                intervalli = date_recenti.diff().dt.days.dropna()
-                intervalli = intervalli[intervalli > 0]
-                if not intervalli.empty:
-                    frequenza_mensile = max(1.0, min(6.0, 30.0 / float(intervalli.mean())))
-
-            impatto_stimato = float(delta_euro * quantita_riferimento * frequenza_mensile)
-
-            alert_list.append({
-                'Prodotto': (prodotto + nota_stagionale)[:50],
-                'Categoria': str(ultimo['Categoria'])[:15],
-                'Fornitore': str(fornitore)[:20],
-                'Storico': storico_str,
-                'Media': media_storico,
-                'Ultimo': prezzo_ultimo,
-                'Aumento_Perc': variazione_perc,
-                'Data': ultimo['DataDocumento'],
-                'N_Fattura': file_origine,
-                'NumeroDocumento': numero_documento,
-                'Trend': trend,
-                'Impatto_Stimato': impatto_stimato,
-                'Delta_Euro': delta_euro,
-            })
-
-    if not alert_list:
+    acquisti = df_fb[pd.to_numeric(df_fb['PrezzoUnitario'], errors='coerce') > 0]
+    base = variazioni_prezzi.prepara(
+        acquisti, descrizione='Descrizione', fornitore='Fornitore',
+        data='DataDocumento', prezzo='PrezzoUnitario', quantita='Quantita',
+    )
+    sel = variazioni_prezzi.selezione(base, soglia_minima)
+    if sel.empty:
         return pd.DataFrame(columns=_ALERT_COLUMNS)
 
-    df_alert = pd.DataFrame(alert_list)
-    df_alert = df_alert.sort_values('Aumento_Perc', ascending=False).reset_index(drop=True)
+    # Prodotto e fornitore prevalenti su TUTTE le righe del gruppo, anche quelle
+    # a prezzo nullo (omaggi): stesso campione del vecchio mode() per gruppo.
+    tutte = df_fb.assign(
+        _desc_key=variazioni_prezzi.chiave(df_fb['Descrizione']),
+        _forn_key=variazioni_prezzi.chiave(df_fb['Fornitore']),
+    )
+    chiavi_sel = base.acquisti.loc[sel['riga_ult'].to_numpy(), ['_desc_key', '_forn_key', '_gid']]
+    tutte = tutte.merge(chiavi_sel, on=['_desc_key', '_forn_key'])
+    prodotti = variazioni_prezzi.prevalenti(tutte, 'Descrizione', tutte['_gid'])
+    fornitori = variazioni_prezzi.prevalenti(tutte, 'Fornitore', tutte['_gid'])
+
+    ultime = base.acquisti.iloc[sel['riga_ult'].to_numpy()]
+    qta_rif = sel['qta_media_ult3'].fillna(1.0)
+    trend_simboli = {
+        variazioni_prezzi.TREND_SALITA_FORTE: '⬆️⬆️',
+        variazioni_prezzi.TREND_DISCESA_FORTE: '⬇️⬇️',
+        variazioni_prezzi.TREND_OSCILLANTE: '↕️',
+        variazioni_prezzi.TREND_SALITA: '⬆️',
+        variazioni_prezzi.TREND_DISCESA: '⬇️',
+    }
+    prodotto = sel.index.map(lambda g: prodotti.get(g))
+    nota = sel['stagionale'].map({True: " ⚠️ >6m", False: ""})
+    df_alert = pd.DataFrame({
+        'Prodotto': [(str(p) + n)[:50] for p, n in zip(prodotto, nota)],
+        'Categoria': ultime['Categoria'].astype(str).str[:15].to_numpy(),
+        'Fornitore': [str(fornitori.get(g))[:20] for g in sel.index],
+        'Storico': sel['storico'].to_numpy(),
+        'Media': sel['media_ult5'].to_numpy(),
+        'Ultimo': sel['prezzo_ult'].to_numpy(),
+        'Aumento_Perc': sel['var_pct'].to_numpy(),
+        'Data': ultime['DataDocumento'].to_numpy(),
+        'N_Fattura': ultime['FileOrigine'].astype(str).to_numpy(),
+        'NumeroDocumento': (
+            ultime['NumeroDocumento'].map(lambda v: str(v or '')).to_numpy()
+            if 'NumeroDocumento' in ultime.columns else ''
+        ),
+        'Trend': sel['trend'].map(trend_simboli).to_numpy(),
+        'Impatto_Stimato': (sel['delta'] * qta_rif * sel['freq_intervalli']).to_numpy(),
+        'Delta_Euro': sel['delta'].to_numpy(),
+    })
+
+    df_alert = df_alert.sort_values('Aumento_Perc', ascending=False, kind='mergesort').reset_index(drop=True)
 
     return df_alert
 
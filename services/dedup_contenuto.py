@@ -0,0 +1,159 @@
+"""Dedup per contenuto: una fattura gia' elaborata non si ri-parsa ne' ri-classifica.
+
+Problema: lo stesso XML arriva spesso piu' volte sulla stessa sede — retry SDI,
+upload manuale di un file gia' arrivato da Invoicetronic, la stessa cartella
+trascinata due volte su /api/upload durante l'onboarding dello storico. Ogni
+volta ripartivano parse, categorizzazione, upsert e passaggio AI. I duplicati
+venivano fermati solo dopo: dal check per nome file (che non vede lo stesso
+documento con nome diverso, es. 'X.xml.p7m' scaricato da SDI e 'X.xml' caricato
+a mano) o da _trova_documento_duplicato_per_identita dentro il salvataggio.
+
+Qui la chiave e' lo SHA-256 dell'XML normalizzato (BOM, fine riga, spazi fra i
+tag: varianti che non cambiano il documento). Dopo un salvataggio riuscito
+(ristorante_id, hash) → file_origine si scrive in `fatture_hash_contenuto` e in
+una LRU per processo. Al prossimo arrivo dello stesso contenuto per la stessa
+sede, upload e queue-worker rispondono subito col documento esistente.
+
+Il risultato NON si fida ciecamente della cache: prima di dichiarare il
+duplicato verifica che su `fatture` ci sia ancora almeno una riga attiva per
+quel file_origine. Se l'utente ha eliminato la fattura, il contenuto si
+rielabora normalmente (e la registrazione si aggiorna). La chiave include la
+sede: lo stesso XML su un'altra sede/tenant e' un documento diverso.
+
+Best-effort: ogni errore di lettura/scrittura equivale a "mai visto" e il
+flusso prosegue come prima.
+"""
+
+from __future__ import annotations
+
+import hashlib
+import re
+import threading
+from collections import OrderedDict
+from typing import Optional, Tuple, Union
+
+from config.logger_setup import get_logger
+
+logger = get_logger('dedup_contenuto')
+
+_TABELLA = "fatture_hash_contenuto"
+
+# Voci (ristorante_id, hash) → file_origine tenute in memoria. Una voce pesa
+# ~200 byte: 20.000 coprono l'onboarding di qualche decina di sedi.
+_LRU_MAX = 20_000
+_HASH_CONTENUTO_CACHE: "OrderedDict[Tuple[str, str], str]" = OrderedDict()
+_lock = threading.Lock()
+
+_RE_SPAZI_FRA_TAG = re.compile(rb'>\s+<')
+
+
+def hash_contenuto_xml(contenuto: Union[bytes, str]) -> str:
+    """SHA-256 esadecimale dell'XML normalizzato."""
+    if isinstance(contenuto, str):
+        contenuto = contenuto.encode('utf-8')
+    norm = contenuto.lstrip(b'\xef\xbb\xbf').replace(b'\r\n', b'\n').replace(b'\r', b'\n').strip()
+    norm = _RE_SPAZI_FRA_TAG.sub(b'><', norm)
+    return hashlib.sha256(norm).hexdigest()
+
+
+def _ricorda(chiave: Tuple[str, str], file_origine: str) -> None:
+    with _lock:
+        _HASH_CONTENUTO_CACHE.pop(chiave, None)
+        _HASH_CONTENUTO_CACHE[chiave] = file_origine
+        while len(_HASH_CONTENUTO_CACHE) > _LRU_MAX:
+            _HASH_CONTENUTO_CACHE.popitem(last=False)
+
+
+def _dimentica(chiave: Tuple[str, str]) -> None:
+    with _lock:
+        _HASH_CONTENUTO_CACHE.pop(chiave, None)
+
+
+def _file_registrato(supabase_client, ristorante_id: str, xml_hash: str) -> Optional[str]:
+    chiave = (str(ristorante_id), xml_hash)
+    with _lock:
+        file_origine = _HASH_CONTENUTO_CACHE.get(chiave)
+        if file_origine is not None:
+            _HASH_CONTENUTO_CACHE.move_to_end(chiave)
+            return file_origine
+    resp = (
+        supabase_client.table(_TABELLA)
+        .select("file_origine")
+        .eq("ristorante_id", str(ristorante_id))
+        .eq("xml_sha256", xml_hash)
+        .limit(1)
+        .execute()
+    )
+    rows = resp.data
+    if not isinstance(rows, list) or not rows or not rows[0].get("file_origine"):
+        return None
+    file_origine = str(rows[0]["file_origine"])
+    _ricorda(chiave, file_origine)
+    return file_origine
+
+
+def _ancora_attivo(supabase_client, ristorante_id: str, file_origine: str) -> bool:
+    from services.db_service import filter_active
+
+    resp = (
+        filter_active(
+            supabase_client.table("fatture")
+            .select("id")
+            .eq("ristorante_id", str(ristorante_id))
+            .eq("file_origine", file_origine)
+        )
+        .limit(1)
+        .execute()
+    )
+    rows = resp.data
+    return isinstance(rows, list) and bool(rows)
+
+
+def documento_gia_elaborato(supabase_client, ristorante_id: Optional[str], xml_hash: str) -> Optional[str]:
+    """file_origine della fattura ATTIVA con lo stesso contenuto su questa sede, o None."""
+    if not ristorante_id or not xml_hash:
+        return None
+    try:
+        file_origine = _file_registrato(supabase_client, ristorante_id, xml_hash)
+        if file_origine is None:
+            return None
+        if _ancora_attivo(supabase_client, ristorante_id, file_origine):
+            return file_origine
+        # Fattura eliminata dopo la registrazione: si rielabora.
+        _dimentica((str(ristorante_id), xml_hash))
+        return None
+    except Exception as exc:
+        logger.warning("Dedup per contenuto: lettura fallita (non bloccante): %s", exc)
+        return None
+
+
+def registra_documento_elaborato(
+    supabase_client,
+    ristorante_id: Optional[str],
+    user_id: Optional[str],
+    xml_hash: str,
+    file_origine: str,
+    righe: int = 0,
+) -> None:
+    """Ricorda che il contenuto `xml_hash` e' stato salvato come `file_origine`."""
+    if not ristorante_id or not xml_hash or not file_origine:
+        return
+    _ricorda((str(ristorante_id), xml_hash), file_origine)
+    try:
+        supabase_client.table(_TABELLA).upsert(
+            {
+                "ristorante_id": str(ristorante_id),
+                "xml_sha256": xml_hash,
+                "user_id": str(user_id) if user_id else None,
+                "file_origine": file_origine,
+                "righe": int(righe or 0),
+            },
+            on_conflict="ristorante_id,xml_sha256",
+        ).execute()
+    except Exception as exc:
+        logger.warning("Dedup per contenuto: registrazione fallita (non bloccante): %s", exc)
+
+
+def svuota_cache() -> None:
+    with _lock:
+        _HASH_CONTENUTO_CACHE.clear()
@@ -771,20 +771,21 @@ def get_documenti_scadenziario(
     ids = [str(r) for r in ristorante_id] if is_multi else [str(ristorante_id)]
 
     # cutoff "Nuovo": stesso criterio del tab Articoli (nuovi_da del ristorante,
-    # fallback 24h), letto per OGNI sede (il cutoff è per-sede, dipende
-    # dall'ultimo caricamento di quella sede).
+    # fallback 24h). Il cutoff è per-sede (dipende dall'ultimo caricamento di
+    # quella sede) ma si legge per tutte le sedi in UNA query: in modalità catena
+    # una lettura per sede erano 15+ round-trip prima ancora della RPC.
     from datetime import datetime as _dt, timedelta as _td, timezone as _tz
     cutoff_default = (_dt.now(_tz.utc) - _td(hours=24)).isoformat()
-    cutoff_per_sede: Dict[str, str] = {}
-    for rid in ids:
-        try:
-            _rist = (
-                sb.table("ristoranti").select("nuovi_da").eq("id", rid).single().execute()
-            )
-            _nuovi_da_raw = (_rist.data or {}).get("nuovi_da")
-        except Exception:
-            _nuovi_da_raw = None
-        cutoff_per_sede[rid] = _nuovi_da_raw or cutoff_default
+    try:
+        _rist_rows = (
+            sb.table("ristoranti").select("id,nuovi_da").in_("id", ids).execute().data or []
+        )
+        _nuovi_da = {str(r.get("id")): r.get("nuovi_da") for r in _rist_rows}
+    except Exception:
+        _nuovi_da = {}
+    cutoff_per_sede: Dict[str, str] = {
+        rid: _nuovi_da.get(rid) or cutoff_default for rid in ids
+    }
 
     # ── Step 1+2: aggregazione lato DB per (file_origine, ristorante_id) via RPC
     # (prima: full-load paginato di tutte le righe fatture + aggregazione Python —
@@ -90,6 +90,7 @@ from fastapi import BackgroundTasks, Depends, FastAPI, File, Form, Header, HTTPE
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import JSONResponse
 from pydantic import BaseModel, Field, model_validator
+from starlette.concurrency import run_in_threadpool
 from starlette.middleware.base import BaseHTTPMiddleware
 from starlette.responses import Response as StarletteResponse
 
@@ -272,26 +273,17 @@ def _run_agent_notturno() -> dict:
         if not allowed_ids:
             return {"classificate": 0, "errori": 0, "elapsed_s": 0}
 
-        # Carica righe in coda (needs_review=True, non cancellate)
-        all_rows: list = []
-        page_size = 1000
-        offset = 0
-        while True:
-            q = (sb.table("fatture")
-                 .select("id,descrizione,categoria,prezzo_unitario,totale_riga,quantita,tipo_documento,needs_review")
-                 .is_("deleted_at", "null")
-                 .in_("user_id", allowed_ids)
-                 .eq("needs_review", True)
-                 .order("id")
-                 .range(offset, offset + page_size - 1))
-            resp = q.execute()
-            chunk = resp.data or []
-            if not chunk:
-                break
-            all_rows.extend(chunk)
-            if len(chunk) < page_size:
-                break
-            offset += page_size
+        # Carica righe in coda (needs_review=True, non cancellate). Keyset su id:
+        # il queue-worker puo' inserire righe durante la scansione notturna e con
+        # l'offset le pagine slittavano; senza cap, la coda va letta tutta.
+        all_rows: list = fetch_all_keyset(
+            lambda: (sb.table("fatture")
+                     .select("id,descrizione,categoria,prezzo_unitario,totale_riga,quantita,tipo_documento,needs_review")
+                     .is_("deleted_at", "null")
+                     .in_("user_id", allowed_ids)
+                     .eq("needs_review", True)),
+            max_rows=sys.maxsize,
+        )
 
         if not all_rows:
             digest = {"classificate": 0, "auto_review": 0, "suggerite": 0, "errori": 0, "elapsed_s": 0}
@@ -393,10 +385,15 @@ def _run_agent_notturno() -> dict:
         # Le righe 'da_verificare' senza soluzione deterministica vengono
         # proposte dall'AI: la categoria NON viene applicata, solo salvata come
         # suggerimento da approvare a mano nello strumento Categorie.
+        # Modalita' batch (default): job JSONL con checkpoint in ai_batch_job,
+        # eseguito fuori dalla quota OpenAI che serve agli upload.
         suggerite_ai = 0
         try:
+            from services.ai_batch_notturno import modalita_notturna
             from services.routers.admin import prepara_suggerimenti_ai
-            res_ai = prepara_suggerimenti_ai(sb, list(allowed_ids), attore="agent-notturno")
+            res_ai = prepara_suggerimenti_ai(
+                sb, list(allowed_ids), attore="agent-notturno", modalita=modalita_notturna(),
+            )
             suggerite_ai = int(res_ai.get("suggerite", 0))
             errori += int(res_ai.get("errori", 0))
         except Exception as exc:
@@ -480,10 +477,12 @@ async def _agent_notturno_loop() -> None:
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    # Gli endpoint sono `def` sincroni: FastAPI li esegue nel threadpool di AnyIO.
-    # Il default e' 40 thread; lo alziamo perche' la Home spara 6-7 chiamate in
-    # parallelo e ogni richiesta occupa un thread per tutta la durata della query
-    # Supabase (sincrona). Cosi' l'event loop resta sempre libero.
+    # Gli endpoint `def` sincroni girano nel threadpool di AnyIO. Il default e' 40
+    # thread; lo alziamo perche' la Home spara 6-7 chiamate in parallelo e ogni
+    # richiesta sincrona occupa un thread per tutta la durata della query
+    # Supabase. Gli endpoint caldi portati ad `async def` (client PostgREST
+    # async, services/supabase_async) non occupano thread durante l'I/O: il
+    # threadpool serve ormai solo agli endpoint non ancora portati.
     try:
         _tp_size = int(os.getenv("WORKER_THREADPOOL_SIZE", "100"))
         anyio.to_thread.current_default_thread_limiter().total_tokens = _tp_size
@@ -493,6 +492,14 @@ async def lifespan(app: FastAPI):
 
     _agent_notturno_load_from_db()
 
+    # Pulizia periodica delle voci scadute di tutte le cache in-process
+    # (utils/ttl_cache): le chiavi lette una volta sola non tornerebbero piu'.
+    from utils.ttl_cache import avvia_sweep
+    avvia_sweep(float(os.getenv("WORKER_CACHE_SWEEP_S", "60")))
+
+    # Invalidazioni degli altri processi (web e queue-worker): vedi services/cache_bus.
+    cache_bus.avvia()
+
     tasks = []
     if _ENABLE_INLINE_QUEUE_PROCESSOR:
         tasks.append(asyncio.create_task(_queue_loop(), name="queue-processor-loop"))
@@ -510,6 +517,11 @@ async def lifespan(app: FastAPI):
                 await t
             except asyncio.CancelledError:
                 pass
+        try:
+            from services.supabase_async import chiudi_async_client
+            await chiudi_async_client()
+        except Exception as exc:
+            logger.warning("Chiusura client PostgREST async fallita: %s", exc)
 
 app = FastAPI(
     lifespan=lifespan,
@@ -550,7 +562,12 @@ from config.constants import MAX_UPLOAD_BYTES as _MAX_BODY_BYTES  # 50 MiB centr
 from config.constants import CATEGORIE_SPESE_GENERALI as _CATEGORIE_SPESE_GENERALI
 from config.constants import CATEGORIA_NON_CLASSIFICATA
 from utils.ttl_cache import TTLCache  # cache TTL thread-safe con single-flight
-from utils.supabase_paging import fetch_all  # paginazione oltre il cap PostgREST
+from services import cache_bus  # invalidazioni propagate agli altri processi
+from utils.righe_colonnari import RigheColonnari  # cache righe di analisi in forma colonnare
+from utils.supabase_paging import (  # paginazione oltre il cap PostgREST
+    fetch_all, fetch_all_keyset, fetch_all_keyset_async,
+)
+from utils.fan_out import in_parallelo  # letture per sede con pool limitato (viste catena)
 
 
 class _ContentSizeLimitMiddleware(BaseHTTPMiddleware):
@@ -953,6 +970,20 @@ def _get_supabase_client():
 get_supabase_client = _get_supabase_client
 
 
+def _get_async_supabase_client():
+    """Client PostgREST async service-role per gli endpoint `async def`.
+
+    Pool httpx condiviso per processo (keep-alive + HTTP/2, vedi
+    services/supabase_async): la richiesta non occupa un thread del threadpool
+    durante il round-trip verso Supabase.
+    """
+    from services.supabase_async import get_async_client
+    try:
+        return get_async_client()
+    except RuntimeError as exc:
+        raise HTTPException(status_code=500, detail=str(exc))
+
+
 def _looks_like_supabase_auth_error(exc: Exception) -> bool:
     msg = str(exc).lower()
     return (
@@ -1300,6 +1331,69 @@ def auth_me(authorization: Optional[str] = Header(None)) -> UserPublic:
     )
 
 
+class AccessToken(BaseModel):
+    access_token: str
+    expires_at: int
+    expires_in: int
+
+
+@app.post(
+    "/api/auth/access-token",
+    response_model=AccessToken,
+    summary="Emette un token di accesso firmato a vita breve",
+    tags=["Auth"],
+    responses={
+        401: {"description": "Sessione non valida"},
+        404: {"description": "Token di accesso non disponibili per questa sessione"},
+    },
+    dependencies=[Depends(_verify_worker_key)],
+)
+def auth_access_token(authorization: Optional[str] = Header(None)) -> AccessToken:
+    """Scambia il token di sessione (cookie) con un token firmato che il worker
+    verifica senza I/O (services/session_token) per i prossimi secondi.
+
+    Solo per le sessioni della tabella `sessioni`: i path legacy e JWT
+    rispondono 404 e il client continua a usare il token di sessione. Ogni
+    emissione conta come attivita' della sessione (tocca_sessione), cosi'
+    il timeout di inattivita' resta quello di prima.
+    """
+    if not authorization or not authorization.lower().startswith("bearer "):
+        raise HTTPException(status_code=401, detail="Token mancante")
+    token = authorization.split(" ", 1)[1].strip()
+    if not token:
+        raise HTTPException(status_code=401, detail="Token vuoto")
+
+    from services import session_token
+    from services.session_service import sessione_attiva, tocca_sessione
+    if not session_token.abilitato() or session_token.e_token_accesso(token):
+        raise HTTPException(status_code=404, detail="Token di accesso non disponibile")
+
+    sb = _get_supabase_client()
+    sessione = sessione_attiva(token, supabase_client=sb)
+    if not sessione:
+        raise HTTPException(status_code=404, detail="Token di accesso non disponibile")
+    resp = (
+        sb.table("users")
+        .select(", ".join(session_token.CAMPI_UTENTE))
+        .eq("id", sessione["user_id"])
+        .eq("attivo", True)
+        .execute()
+    )
+    if not isinstance(resp.data, list) or not resp.data:
+        raise HTTPException(status_code=401, detail="Sessione non valida o scaduta")
+    tocca_sessione(token, supabase_client=sb)
+
+    emesso = session_token.emetti(resp.data[0], sessione["id"])
+    if emesso is None:
+        raise HTTPException(status_code=404, detail="Token di accesso non disponibile")
+    access_token, scadenza = emesso
+    return AccessToken(
+        access_token=access_token,
+        expires_at=scadenza,
+        expires_in=max(0, scadenza - int(time.time())),
+    )
+
+
 @app.post(
     "/api/auth/accetta-privacy",
     summary="Registra il consenso privacy esplicito (retroattivo per account pre-esistenti)",
@@ -1404,16 +1498,16 @@ class DashboardStats(BaseModel):
 # l'invalidazione tocca solo il processo che ha servito la POST di cambio sede,
 # gli altri 3 possono servire il valore vecchio fino allo scadere del TTL. Un TTL
 # piu' basso (era 5s) accorcia questa finestra multi-processo, non la elimina.
-_SEDE_ATTIVA_CACHE: Dict[str, tuple] = {}
+# LRU limitata per lo stesso motivo di auth_service._SESSIONE_CACHE. Il valore
+# puo' essere None (nessuna sede scelta): il miss si riconosce dal sentinel.
 _SEDE_ATTIVA_TTL = 1.0  # secondi
+_SEDE_ATTIVA_CACHE = TTLCache(ttl=_SEDE_ATTIVA_TTL, nome="sede_attiva", max_entries=5000)
+_SEDE_MANCANTE = object()
 
 
 def _invalidate_sede_attiva_cache(token: Optional[str] = None) -> None:
     """Invalida la micro-cache della sede attiva (un token, o tutta)."""
-    if token is None:
-        _SEDE_ATTIVA_CACHE.clear()
-    else:
-        _SEDE_ATTIVA_CACHE.pop(token, None)
+    _SEDE_ATTIVA_CACHE.invalidate(token)
 
 
 def _resolve_user_from_token(authorization: Optional[str]) -> Dict[str, Any]:
@@ -1437,13 +1531,15 @@ def _resolve_user_from_token(authorization: Optional[str]) -> Dict[str, Any]:
     # condividono una SELECT invece di rifarla 6 volte; lo switch invalida la cache
     # (account_cambia_sede), quindi resta immediato.
     # Non tocchiamo un eventuale ristorante_id esplicito (impersonazione admin).
-    if not user.get("ristorante_id"):
-        import time as _t
-        _now = _t.monotonic()
-        _cached = _SEDE_ATTIVA_CACHE.get(token)
-        if _cached and (_now - _cached[0]) < _SEDE_ATTIVA_TTL:
-            if _cached[1]:
-                user["ultimo_ristorante_id"] = _cached[1]
+    # Il token di accesso firmato porta gia' la sede letta all'emissione, e il
+    # cambio sede lo revoca (session_service.invalida_token_accesso_utente):
+    # nessuna rilettura.
+    from services.session_token import e_token_accesso
+    if not user.get("ristorante_id") and not e_token_accesso(token):
+        _cached = _SEDE_ATTIVA_CACHE.get(token, _SEDE_MANCANTE)
+        if _cached is not _SEDE_MANCANTE:
+            if _cached:
+                user["ultimo_ristorante_id"] = _cached
         else:
             try:
                 sb = _get_supabase_client()
@@ -1455,7 +1551,7 @@ def _resolve_user_from_token(authorization: Optional[str]) -> Dict[str, Any]:
                     .execute()
                 )
                 rid_fresh = (fresh.data or {}).get("ultimo_ristorante_id")
-                _SEDE_ATTIVA_CACHE[token] = (_now, rid_fresh)
+                _SEDE_ATTIVA_CACHE.set(token, rid_fresh)
                 if rid_fresh:
                     user["ultimo_ristorante_id"] = rid_fresh
             except Exception as exc:
@@ -1464,9 +1560,97 @@ def _resolve_user_from_token(authorization: Optional[str]) -> Dict[str, Any]:
     return user
 
 
+async def _resolve_user_from_token_async(authorization: Optional[str]) -> Dict[str, Any]:
+    """_resolve_user_from_token per gli endpoint `async def`.
+
+    La verifica sessione passa da auth_service (sincrono, con cache in-process):
+    la eseguiamo nel threadpool, dove di norma resta per il solo hit di cache.
+    E' il tratto breve della richiesta; le query dati restano sul client async.
+    """
+    return await run_in_threadpool(_resolve_user_from_token, authorization)
+
+
+async def _resolve_ristorante_id_async(user: Dict[str, Any], asb) -> Optional[str]:
+    """Gemello async di _resolve_ristorante_id (stessa priorita', stessa query)."""
+    rid = user.get("ristorante_id") or user.get("ultimo_ristorante_id")
+    if rid:
+        return str(rid)
+    uid = user.get("id")
+    if not uid:
+        return None
+    try:
+        resp = await (
+            asb.table("ristoranti")
+            .select("id")
+            .eq("user_id", uid)
+            .eq("attivo", True)
+            .eq("sede_tecnica", False)   # mai la sede-contenitore come sede di default
+            .order("created_at")
+            .limit(1)
+            .execute()
+        )
+        if resp.data:
+            return str(resp.data[0]["id"])
+    except Exception:
+        pass
+    return None
+
+
 # Cache in-process per /api/dashboard/stats (full-load + aggregazione Python).
-_DASHBOARD_STATS_CACHE: Dict[str, tuple] = {}
-_DASHBOARD_STATS_TTL = 60.0  # secondi
+# Invalidata con le righe fatture (_invalidate_fatture_rows_cache, anche dagli
+# altri processi via cache_bus).
+_DASHBOARD_STATS_TTL = 300.0  # secondi
+_DASHBOARD_STATS_CACHE = TTLCache(ttl=_DASHBOARD_STATS_TTL, nome="dashboard_stats", max_entries=2000)
+
+
+async def _dashboard_stats_da_cubo(asb, user_id: str, ristorante_id: str) -> DashboardStats:
+    """DashboardStats della sede dal cubo costi_mensili_cubo, senza caricare le righe.
+
+    Spesa, mesi e top vengono dalle celle per fornitore (poche migliaia al
+    massimo per sede); documenti, prima e ultima data da tre letture puntuali.
+    I documenti si contano su fatture_documenti (una riga per documento), come
+    il conteggio fatture dell'admin.
+    """
+    from services import costi_cubo
+
+    today = _oggi_rome()
+    mese_corrente_key = today.strftime("%Y-%m")
+    mese_precedente_key = (today.replace(day=1) - timedelta(days=1)).strftime("%Y-%m")
+
+    def _date_fatture():
+        return (
+            asb.table("fatture")
+            .select("data_documento")
+            .eq("user_id", user_id)
+            .eq("ristorante_id", ristorante_id)
+            .is_("deleted_at", "null")
+            .not_.is_("data_documento", "null")
+        )
+
+    # Prima il cubo: se non risponde si ricade sulle righe senza altre letture.
+    celle = await costi_cubo.leggi_celle_async(asb, ristorante_id, user_id)
+    documenti, prima, ultima = await asyncio.gather(
+        asb.table("fatture_documenti").select("file_origine", count="exact")
+        .eq("user_id", user_id).eq("ristorante_id", ristorante_id)
+        .is_("deleted_at", "null").limit(1).execute(),
+        _date_fatture().order("data_documento").limit(1).execute(),
+        _date_fatture().order("data_documento", desc=True).limit(1).execute(),
+    )
+    r = costi_cubo.riepilogo_dashboard(celle, mese_corrente_key, mese_precedente_key)
+    return DashboardStats(
+        kpi=DashboardKpi(
+            fatture_uniche=int(documenti.count or 0),
+            righe_totali=r["righe_totali"],
+            spesa_totale=round(r["spesa_totale"], 2),
+            spesa_mese_corrente=round(r["spesa_mese_corrente"], 2),
+            spesa_mese_precedente=round(r["spesa_mese_precedente"], 2),
+            prima_fattura=str(prima.data[0]["data_documento"]) if prima.data else None,
+            ultima_fattura=str(ultima.data[0]["data_documento"]) if ultima.data else None,
+        ),
+        spesa_mensile=[SpesaMensilePoint(mese=m, spesa=round(v, 2)) for m, v in r["spesa_mensile"]],
+        top_fornitori=[TopItem(nome=n, spesa=round(v, 2), righe=k) for n, v, k in r["top_fornitori"]],
+        top_categorie=[TopItem(nome=n, spesa=round(v, 2), righe=k) for n, v, k in r["top_categorie"]],
+    )
 
 
 @app.get(
@@ -1476,29 +1660,38 @@ _DASHBOARD_STATS_TTL = 60.0  # secondi
     tags=["Dashboard"],
     dependencies=[Depends(_verify_worker_key)],
 )
-def dashboard_stats(authorization: Optional[str] = Header(None)) -> DashboardStats:
-    from datetime import date, timedelta
-    from collections import defaultdict
-    import time as _time
-
-    user = _resolve_user_from_token(authorization)
-    user_id = str(user["id"])
-
-    from services import get_supabase_client
-    supabase_client = get_supabase_client()
+async def dashboard_stats(authorization: Optional[str] = Header(None)) -> DashboardStats:
+    # Endpoint async: le query passano dal client PostgREST async e non tengono
+    # un thread del threadpool per tutto il round-trip (la Home lo chiama in
+    # parallelo alle altre 5-6 card).
+    user = await _resolve_user_from_token_async(authorization)
+    supabase_client = _get_async_supabase_client()
 
     # Scoping per ristorante: senza, la Home aggregava TUTTI i ristoranti dell'utente
     # mentre Margini/Fatture/Prezzi mostrano un solo ristorante -> KPI Home incoerenti
     # col resto dell'app appena attivo il multi-ristorante. Allineato a _build_fatture_base_query.
-    ristorante_id = _resolve_ristorante_id(user, supabase_client)
+    ristorante_id = await _resolve_ristorante_id_async(user, supabase_client)
+    return await _dashboard_stats_calcola(supabase_client, str(user["id"]), ristorante_id)
+
+
+async def _dashboard_stats_calcola(
+    supabase_client, user_id: str, ristorante_id: Optional[str],
+) -> DashboardStats:
+    """Corpo di /api/dashboard/stats con utente e sede gia' risolti.
+
+    Condiviso dall'endpoint dedicato e da /api/home/bundle, che risolve token e
+    sede una volta sola per tutte le card della Home.
+    """
+    from datetime import timedelta
+    from collections import defaultdict
 
     # Cache in-process: l'endpoint fa un full-load di tutte le righe del ristorante
     # e aggrega in Python. Su clienti grandi e' costoso; un TTL breve evita di
     # rieseguirlo a ogni richiesta ravvicinata (coerente con _HOME_KPI_CACHE).
     _cache_key = f"dashstats:{user_id}:{ristorante_id}"
     _cached = _DASHBOARD_STATS_CACHE.get(_cache_key)
-    if _cached and (_time.monotonic() - _cached[0]) < _DASHBOARD_STATS_TTL:
-        return _cached[1]
+    if _cached is not None:
+        return _cached
 
     # Via veloce: aggregazione lato DB in un'unica RPC (GROUP BY) invece di
     # scaricare TUTTE le righe (LAND: 6.315 in 7 query paginate) e ciclare in
@@ -1506,10 +1699,10 @@ def dashboard_stats(authorization: Optional[str] = Header(None)) -> DashboardSta
     # corrente/precedente su fuso Roma, ultimi 12 mesi, top 5). Se per qualunque
     # motivo fallisce, si ricade sul percorso Python storico (resta sotto).
     try:
-        _rpc = supabase_client.rpc(
+        _rpc = await supabase_client.rpc(
             "dashboard_stats_aggregata",
             {"p_user_id": user_id, "p_ristorante_id": ristorante_id},
-        ).execute()
+        )
         _agg = _rpc.data
         if _agg:
             _k = _agg.get("kpi") or {}
@@ -1536,33 +1729,32 @@ def dashboard_stats(authorization: Optional[str] = Header(None)) -> DashboardSta
                     for t in (_agg.get("top_categorie") or [])
                 ],
             )
-            _DASHBOARD_STATS_CACHE[_cache_key] = (_time.monotonic(), _result)
+            _DASHBOARD_STATS_CACHE.set(_cache_key, _result)
             return _result
     except Exception as _rpc_err:
-        logger.warning("dashboard_stats: RPC aggregata fallita, fallback full-load Python: %s", _rpc_err)
+        logger.warning("dashboard_stats: RPC aggregata fallita, fallback sul cubo costi: %s", _rpc_err)
 
-    rows: List[Dict[str, Any]] = []
-    page_size = 1000
-    start = 0
-    while True:
-        _q = (
-            supabase_client.table("fatture")
-            .select("file_origine,data_documento,fornitore,categoria,totale_riga")
-            .eq("user_id", user_id)
-            .is_("deleted_at", "null")
-        )
-        if ristorante_id:
-            _q = _q.eq("ristorante_id", ristorante_id)
-        resp = (
-            _q
-            .range(start, start + page_size - 1)
-            .execute()
-        )
-        batch = resp.data or []
-        rows.extend(batch)
-        if len(batch) < page_size:
-            break
-        start += page_size
+    # Fallback: il cubo costi_mensili_cubo ha gia' i totali per mese e fornitore
+    # della sede. Solo senza sede o se anche il cubo non risponde si caricano
+    # tutte le righe e si aggrega in Python (percorso storico, sotto).
+    if ristorante_id:
+        try:
+            _result = await _dashboard_stats_da_cubo(supabase_client, user_id, ristorante_id)
+            _DASHBOARD_STATS_CACHE.set(_cache_key, _result)
+            return _result
+        except Exception as _cubo_err:
+            logger.warning("dashboard_stats: cubo costi non leggibile, fallback full-load Python: %s", _cubo_err)
+
+    _q = (
+        supabase_client.table("fatture")
+        .select("id,file_origine,data_documento,fornitore,categoria,totale_riga")
+        .eq("user_id", user_id)
+        .is_("deleted_at", "null")
+    )
+    if ristorante_id:
+        _q = _q.eq("ristorante_id", ristorante_id)
+    # Aggregazione: l'ordine non conta, keyset su id (builder async immutabile).
+    rows: List[Dict[str, Any]] = await fetch_all_keyset_async(lambda: _q)
 
     today = _oggi_rome()
     mese_corrente_key = today.strftime("%Y-%m")
@@ -1633,7 +1825,7 @@ def dashboard_stats(authorization: Optional[str] = Header(None)) -> DashboardSta
         top_fornitori=top_fornitori,
         top_categorie=top_categorie,
     )
-    _DASHBOARD_STATS_CACHE[_cache_key] = (_time.monotonic(), _result)
+    _DASHBOARD_STATS_CACHE.set(_cache_key, _result)
     return _result
 
 
@@ -1811,21 +2003,20 @@ async def upload_invoice(
     cross_sede: Optional[bool] = None
     sedi_attive = _carica_sedi_attive_per_user(user_id, supabase_client)
 
-    # Parse del dict XML una sola volta (serve a P.IVA cessionario + indirizzo).
-    # Stesso decoder con fallback encoding + guard XXE di estrai_dati_da_xml
-    # (decodifica_xml_sicuro): prima qui si chiamava xmltodict.parse(contents)
-    # nudo, che su encoding non-UTF8 (fornitori cinesi ecc.) falliva silenziosamente
-    # -> fattura_dict vuoto -> P.IVA/indirizzo non estratti -> routing ricadeva sul
+    # Parse della testata XML una sola volta (serve a P.IVA cessionario + indirizzo).
+    # Stesso parser con fallback encoding + guard XXE di estrai_dati_da_xml
+    # (parse_fattura): prima qui si chiamava xmltodict.parse(contents) nudo, che
+    # su encoding non-UTF8 (fornitori cinesi ecc.) falliva silenziosamente ->
+    # fattura_dict vuoto -> P.IVA/indirizzo non estratti -> routing ricadeva sul
     # fallback (sede attiva) bypassando la guardia P.IVA invece di smistare.
+    # La testata ha la forma xmltodict attesa dagli estrattori; il primo body
+    # arriva gia' tipizzato (numero/data/importo per il payload_meta AMBIGUO).
+    _corpo_xml = None
     try:
-        import xmltodict
-        from services.invoice_service import decodifica_xml_sicuro
-        _contenuto = decodifica_xml_sicuro(contents)
-        _doc = xmltodict.parse(_contenuto)
-        _root = list(_doc.keys())
-        fattura_dict = _doc[_root[0]] if _root else {}
-        if not isinstance(fattura_dict, dict):
-            fattura_dict = {}
+        from services.fatturapa_parser import parse_fattura
+        _fattura_pa = parse_fattura(contents, solo_primo_corpo=True)
+        fattura_dict = _fattura_pa.testata
+        _corpo_xml = _fattura_pa.corpi[0] if _fattura_pa.corpi else None
     except Exception as parse_err:
         logger.warning("upload: parse XML per smistamento fallito: %s", parse_err)
         fattura_dict = {}
@@ -1894,13 +2085,10 @@ async def upload_invoice(
         try:
             from utils.formatters import safe_get as _safe_get
             _hdr = fattura_dict.get("FatturaElettronicaHeader", {}) if isinstance(fattura_dict, dict) else {}
-            _body = fattura_dict.get("FatturaElettronicaBody", {}) if isinstance(fattura_dict, dict) else {}
-            if isinstance(_body, list):
-                _body = _body[0] if _body else {}
             _pc = _safe_get(_hdr, ["CedentePrestatore", "DatiAnagrafici", "IdFiscaleIVA", "IdCodice"], default=None, keep_list=False)
-            _num = _safe_get(_body, ["DatiGenerali", "DatiGeneraliDocumento", "Numero"], default=None, keep_list=False)
-            _data = _safe_get(_body, ["DatiGenerali", "DatiGeneraliDocumento", "Data"], default=None, keep_list=False)
-            _imp = _safe_get(_body, ["DatiGenerali", "DatiGeneraliDocumento", "ImportoTotaleDocumento"], default=None, keep_list=False)
+            _num = _corpo_xml.numero if _corpo_xml else None
+            _data = _corpo_xml.data if _corpo_xml else None
+            _imp = _corpo_xml.importo_totale if _corpo_xml else None
             if _pc:
                 _payload_meta_ambiguo["piva_cedente"] = str(_pc)
             if _num:
@@ -2043,6 +2231,26 @@ async def upload_invoice(
         except Exception as dup_err:
             logger.warning(f"Check duplicato fallito (non bloccante): {dup_err}")
 
+    # Stesso CONTENUTO gia' salvato su questa sede con un altro nome (es. SDI
+    # 'X.xml.p7m' e poi 'X.xml' a mano, o la cartella dello storico ricaricata):
+    # si risponde subito col documento esistente, senza parse/salvataggio/AI.
+    from services.dedup_contenuto import (
+        documento_gia_elaborato, hash_contenuto_xml, registra_documento_elaborato,
+    )
+    hash_contenuto = hash_contenuto_xml(contents)
+    gia_elaborato = documento_gia_elaborato(supabase_client, ristorante_id, hash_contenuto)
+    if gia_elaborato:
+        return UploadInvoiceResponse(
+            success=False,
+            filename=filename_canonico,
+            righe_salvate=0,
+            error=f"ALREADY_LOADED:{gia_elaborato}",
+            routing_status=routing_status,
+            sede_assegnata=sede_assegnata,
+            cross_sede=cross_sede,
+            elapsed_ms=int((_time.monotonic() - t0) * 1000),
+        )
+
     # Parse fattura
     from services.invoice_service import estrai_dati_da_xml, salva_fattura_processata
     from services.ai_service import carica_memoria_completa
@@ -2091,6 +2299,11 @@ async def upload_invoice(
             elapsed_ms=elapsed_ms,
         )
 
+    registra_documento_elaborato(
+        supabase_client, ristorante_id, user_id, hash_contenuto, filename,
+        righe=result.get("righe", len(righe)),
+    )
+
     # ── Categorizzazione AI post-upload (in-process) ──────────────────────────
     # CAUSA RADICE cert. SUSHILAND 26/06: l'upload via worker (Next.js -> qui)
     # NON faceva mai girare l'AI — quella era agganciata solo al vecchio flusso
@@ -2342,6 +2555,21 @@ class HomeKpiResponse(BaseModel):
     mol_mensile_anno: Optional[int] = None       # anno di riferimento dello sparkline
 
 
+class HomeBundleResponse(BaseModel):
+    """Tutte le card della Home in una risposta (/api/home/bundle).
+
+    Ogni campo ha la stessa forma dell'endpoint della card. None = card non
+    richiesta, fallita, o (solo alert_prezzi) non pronta entro il budget: il
+    client la chiede all'endpoint dedicato.
+    """
+    stats: Optional[DashboardStats] = None
+    kpi: Optional[HomeKpiResponse] = None
+    briefing: Optional[BriefingResponse] = None
+    salute: Optional[SaluteResponse] = None
+    alert_prezzi: Optional[AlertPrezziResponse] = None
+    notifiche: Optional[NotificheResponse] = None
+
+
 # Avvisi mostrabili nel configuratore, in ordine di gerarchia. I due upload
 # falliti sono "bloccati": sempre attivi (guasti tecnici). Decisione Mattia.
 _CONFIG_TOPICS: List[tuple] = [
@@ -2406,7 +2634,6 @@ def get_notifiche(
     include_dismissed: bool = False,
 ) -> NotificheResponse:
     user = _resolve_user_from_token(authorization)
-    user_id = str(user["id"])
 
     from services import get_supabase_client
     supabase_client = get_supabase_client()
@@ -2415,20 +2642,17 @@ def get_notifiche(
     # non deve vedere in campanella le notifiche delle ALTRE sedi. Senza questo
     # filtro una sede a 0 fatture mostrava i tag/scadenze di un'altra sede.
     ristorante_id = _resolve_ristorante_id(user, supabase_client)
+    ctx = _HomeContesto(user, supabase_client, ristorante_id)
+    return _notifiche_calcola(ctx, include_dismissed=include_dismissed)
 
-    query = (
-        supabase_client.table("notification_inbox")
-        .select("id,topic_key,source_type,severity,title,body,action_page,dismissed_at,expires_at,created_at")
-        .eq("user_id", user_id)
-        .or_("expires_at.is.null,expires_at.gt." + __import__("datetime").datetime.now(__import__("datetime").timezone.utc).isoformat())
-        .order("created_at", desc=True)
-        .limit(100)
-    )
-    if ristorante_id:
-        query = query.eq("ristorante_id", ristorante_id)
 
-    resp = query.execute()
-    rows = resp.data or []
+def _notifiche_calcola(ctx: "_HomeContesto", include_dismissed: bool = False) -> NotificheResponse:
+    """Corpo di /api/notifiche sul contesto Home (utente e sede gia' risolti)."""
+    supabase_client = ctx.sb
+    ristorante_id = ctx.ristorante_id
+    # Stessa lettura di notification_inbox del briefing: nel bundle Home la
+    # fanno una volta sola per entrambi.
+    rows = list(ctx.inbox())
 
     if not include_dismissed:
         rows = [r for r in rows if not r.get("dismissed_at")]
@@ -2441,7 +2665,7 @@ def get_notifiche(
     td: Optional[List[Any]] = None  # topics_disabled, riusato anche per i live sotto
     try:
         if ristorante_id:
-            td = _get_assistant_preferences(ristorante_id, supabase_client).get("topics_disabled")
+            td = ctx.preferenze().get("topics_disabled")
             rows = _filtra_notifiche_topic_spenti(rows, td)
     except Exception as exc:
         logger.warning("get_notifiche: filtro topics_disabled fallito: %s", exc)
@@ -3554,7 +3778,32 @@ def _chat_query_costi(
     righe: List[Dict[str, Any]] = []
     trovato_come = None  # "categoria" | "prodotto" | None
 
-    if termine:
+    # Senza termine ne' fornitore il dettaglio e' per categoria: il cubo
+    # costi_mensili_cubo ha gia' i totali della sede per mese documento e
+    # categoria, quindi niente righe da scaricare e nessun tetto. Le ricerche per
+    # prodotto o fornitore restano sulle righe (la descrizione non e' nel cubo).
+    celle_cubo: Optional[List[Dict[str, Any]]] = None
+    if not termine and not fornitore and ristorante_id:
+        from services import costi_cubo
+        try:
+            celle_cubo = [
+                c for c in costi_cubo.leggi_mensile(
+                    [ristorante_id], anno, anno, base=costi_cubo.BASE_DOCUMENTO,
+                    user_id=user_id, supabase_client=supabase_client,
+                )
+                if c.get("fonte") != costi_cubo.FONTE_QUOTA
+                and (not (mese and anno) or int(c.get("mese") or 0) == mese)
+            ]
+        except Exception as exc:
+            logger.warning("query_costi: cubo costi non leggibile, uso le righe: %s", exc)
+
+    if celle_cubo is not None:
+        # Ogni cella vale come una riga aggregata della sua categoria.
+        righe = [
+            {"categoria": c.get("categoria"), "totale_riga": c.get("totale"), "n_righe": c.get("n_righe")}
+            for c in celle_cubo
+        ]
+    elif termine:
         # 1) prova esatta sul campo indicato; 2) ovunque; 3) varianti ovunque.
         campo_pref = "categoria" if categoria else "prodotto"
         for term_val in _varianti(termine):
@@ -3582,10 +3831,11 @@ def _chat_query_costi(
         dettaglio[k] = dettaglio.get(k, 0) + float(r.get("totale_riga") or 0)
     top = sorted(dettaglio.items(), key=lambda x: x[1], reverse=True)[:15]
 
+    n_righe = sum(int(r.get("n_righe") or 0) for r in righe) if celle_cubo is not None else len(righe)
     risultato = {
         "periodo": periodo_label,
         "totale": round(totale, 2),
-        "righe_trovate": len(righe),
+        "righe_trovate": n_righe,
         "trovato_come": trovato_come,
         "dettaglio": [{"voce": k, "spesa": round(v, 2)} for k, v in top],
     }
@@ -3605,7 +3855,7 @@ def _chat_query_costi(
     # Troncamento: se abbiamo riempito il tetto, il totale e' PARZIALE (mancano le
     # righe piu' vecchie, ordiniamo per data desc). Lo dichiariamo cosi' l'AI non
     # spaccia un parziale per completo e suggerisce di restringere il periodo.
-    if len(righe) >= _CHAT_COSTI_LIMIT:
+    if celle_cubo is None and len(righe) >= _CHAT_COSTI_LIMIT:
         risultato["totale_parziale"] = True
         risultato["nota"] = (
             "Sono state considerate solo le righe piu' recenti (molto storico): "
@@ -5441,8 +5691,8 @@ _LIVE_TOPICS_DATI_MANCANTI = frozenset({
 # OGNI pagina (badge campanella). Senza cache, ~7 query leggere ad ogni
 # navigazione. TTL breve: al massimo 60s di ritardo dopo l'inserimento di un dato
 # (poi la card e la campanella tornano allineate).
-_LIVE_SEGNALI_CACHE: Dict[str, tuple] = {}
 _LIVE_SEGNALI_TTL = 60.0  # secondi
+_LIVE_SEGNALI_CACHE = TTLCache(ttl=_LIVE_SEGNALI_TTL, nome="segnali_live", max_entries=2000)
 
 
 def _segnali_live_dati_mancanti(
@@ -5456,11 +5706,9 @@ def _segnali_live_dati_mancanti(
     Best-effort: ogni blocco e' isolato, un errore non azzera gli altri segnali.
     Cache in-process TTL 60s, keyed per ristorante.
     """
-    import time as _time
-    _now = _time.monotonic()
     _cached = _LIVE_SEGNALI_CACHE.get(ristorante_id)
-    if _cached and (_now - _cached[0]) < _LIVE_SEGNALI_TTL:
-        return list(_cached[1])
+    if _cached is not None:
+        return list(_cached)
 
     out: List[Dict[str, Any]] = []
     try:
@@ -5480,7 +5728,7 @@ def _segnali_live_dati_mancanti(
     except Exception as exc:
         logger.warning("segnali live: fatture mancanti fallite: %s", exc)
 
-    _LIVE_SEGNALI_CACHE[ristorante_id] = (_now, list(out))
+    _LIVE_SEGNALI_CACHE.set(ristorante_id, list(out))
     return out
 
 
@@ -5611,7 +5859,9 @@ def _briefing_response_from_snapshot(snapshot: Dict[str, Any], nome: Optional[st
 # valore fino allo scadere del TTL. Accettato consapevolmente: il TTL e' breve e i
 # dati (toggle/nome) cambiano di rado. Per coerenza immediata cross-processo
 # servirebbe una cache condivisa (Redis), sproporzionata all'attuale scala.
-_ASSIST_PREF_CACHE = TTLCache(ttl=30.0)  # single-flight: vedi utils/ttl_cache.py
+_ASSIST_PREF_CACHE = TTLCache(  # single-flight: vedi utils/ttl_cache.py
+    ttl=30.0, nome="assistant_preferences", max_entries=5000,
+)
 
 
 def _invalidate_assist_pref_cache(ristorante_id: Optional[str] = None) -> None:
@@ -5654,18 +5904,21 @@ def _get_assistant_preferences(ristorante_id: str, supabase_client) -> Dict[str,
 
 
 def _briefing_nome_referente(
-    nome: Optional[str], ristorante_id: Optional[str], supabase_client
+    nome: Optional[str], ristorante_id: Optional[str], supabase_client,
+    pref: Optional[Dict[str, Any]] = None,
 ) -> tuple[Optional[str], List[str]]:
     """Legge override nome + topic spenti da assistant_preferences (cachata).
 
     Estratta per essere riusabile sia dal fast-path cache-first (che serve lo
     snapshot di oggi senza ricalcolare nulla, ma ha comunque bisogno del nome
-    corretto per il saluto) sia dal path completo.
+    corretto per il saluto) sia dal path completo. `pref` gia' letta (contesto
+    Home) evita di ripassare dalla cache.
     """
     topics_disabled: List[str] = []
     if not ristorante_id:
         return nome, topics_disabled
-    pref = _get_assistant_preferences(ristorante_id, supabase_client)
+    if pref is None:
+        pref = _get_assistant_preferences(ristorante_id, supabase_client)
     if pref.get("nome_referente"):
         nome = pref["nome_referente"]
     td = pref.get("topics_disabled") or []
@@ -5674,6 +5927,102 @@ def _briefing_nome_referente(
     return nome, topics_disabled
 
 
+def _leggi_notification_inbox(
+    user_id: str, ristorante_id: Optional[str], supabase_client,
+) -> List[Dict[str, Any]]:
+    """Notifiche persistite non scadute dell'utente (ultime 100), filtrate per sede.
+
+    Archiviate comprese: la campanella le mostra a richiesta, il briefing le
+    scarta. Colonne = unione di quelle usate da /api/notifiche e dal briefing.
+    """
+    from datetime import datetime as _dt, timezone as _tz
+    q = (
+        supabase_client.table("notification_inbox")
+        .select("id,topic_key,source_type,severity,title,body,action_page,payload,dismissed_at,expires_at,created_at,source_event_at,dedupe_key")
+        .eq("user_id", user_id)
+        .or_("expires_at.is.null,expires_at.gt." + _dt.now(_tz.utc).isoformat())
+        .order("created_at", desc=True)
+        .limit(100)
+    )
+    if ristorante_id:
+        q = q.eq("ristorante_id", ristorante_id)
+    return q.execute().data or []
+
+
+class _HomeContesto:
+    """Dati condivisi dalle card della Home per UNA richiesta.
+
+    Utente e sede arrivano gia' risolti; le letture comuni a piu' card
+    (preferenze assistente, notification_inbox, margini_mensili, override
+    modalita' mensile, costi automatici dell'anno) si fanno al primo uso e
+    restano qui per le altre. Vive quanto la richiesta: niente invalidazione,
+    le cache in-process restano quelle dei singoli loader.
+
+    Thread-safe: /api/home/bundle fa girare le card in parallelo nel
+    threadpool; un lock per chiave fa aspettare al secondo chiamante il
+    risultato del primo invece di rifare la query. Un errore non resta in
+    memoria: il chiamante successivo riprova.
+    """
+
+    def __init__(self, user: Dict[str, Any], sb, ristorante_id: Optional[str]):
+        self.user = user
+        self.user_id = str(user["id"])
+        self.sb = sb
+        self.ristorante_id = ristorante_id
+        self._valori: Dict[tuple, Any] = {}
+        self._lock = threading.Lock()
+        self._lock_chiave: Dict[tuple, threading.Lock] = {}
+
+    def _una_volta(self, chiave: tuple, carica):
+        with self._lock:
+            if chiave in self._valori:
+                return self._valori[chiave]
+            lock = self._lock_chiave.setdefault(chiave, threading.Lock())
+        with lock:
+            if chiave not in self._valori:
+                self._valori[chiave] = carica()
+            return self._valori[chiave]
+
+    def preferenze(self) -> Dict[str, Any]:
+        """Riga assistant_preferences della sede ({} senza sede o su errore)."""
+        if not self.ristorante_id:
+            return {}
+        return self._una_volta(
+            ("preferenze",),
+            lambda: _get_assistant_preferences(self.ristorante_id, self.sb),
+        )
+
+    def inbox(self) -> List[Dict[str, Any]]:
+        """notification_inbox dell'utente sulla sede (vedi _leggi_notification_inbox)."""
+        return self._una_volta(
+            ("inbox",),
+            lambda: _leggi_notification_inbox(self.user_id, self.ristorante_id, self.sb),
+        )
+
+    def margini_anno(self, anno: int) -> Dict[int, Dict[str, Any]]:
+        """margini_mensili dell'anno, {mese: riga}. Da copiare prima di modificarla."""
+        from services.margine_service import carica_margini_anno
+        return self._una_volta(
+            ("margini", anno),
+            lambda: carica_margini_anno(self.user_id, self.ristorante_id, anno),
+        )
+
+    def override_mensili(self, anno: int) -> Dict[tuple, Dict[str, float]]:
+        """Mesi dell'anno in modalita' 'mensile' (vedi _load_mensile_overrides)."""
+        return self._una_volta(
+            ("override", anno),
+            lambda: _load_mensile_overrides(self.sb, self.ristorante_id, [anno]),
+        )
+
+    def costi_automatici_anno(self, anno: int) -> tuple:
+        """(food, spese) per mese dalle fatture, come la card 'I tuoi conti'."""
+        from services.margine_service import calcola_costi_automatici_per_anno_sql
+        return self._una_volta(
+            ("costi", anno),
+            lambda: calcola_costi_automatici_per_anno_sql(self.user_id, self.ristorante_id, anno),
+        )
+
+
 # Soglia di assenza oltre cui scatta il bentornato di rientro (giorni). Tenuta
 # alta di proposito: il messaggio deve essere RARO, solo per assenze vere.
 _RIENTRO_GIORNI = 7
@@ -5967,6 +6316,7 @@ def _briefing_raccogli_notifiche(
     user_id: str, ristorante_id: Optional[str], supabase_client,
     includi_alert_prezzi: bool = True,
     alert_prezzi_budget_generoso: bool = False,
+    contesto: Optional["_HomeContesto"] = None,
 ) -> List[Dict[str, Any]]:
     """Raccoglie le notifiche attive + i segnali LIVE che alimentano il briefing.
 
@@ -5990,9 +6340,10 @@ def _briefing_raccogli_notifiche(
     sua funzione NON gira proprio (non si limita a filtrare il risultato a valle).
     Conta soprattutto per l'alert prezzi (budget 4s) e i check con query dedicate:
     calcolarli per poi buttarli e' lavoro sprecato.
-    """
-    from datetime import datetime as _dt, timezone as _tz
 
+    `contesto` (load Home in corso): preferenze e notification_inbox arrivano
+    dalle letture gia' fatte per le altre card invece che da query proprie.
+    """
     # Topic spenti dal configuratore (espansi alle key dello stesso tema) + giorni
     # di chiusura settimanali. I topic bloccati (upload falliti) non si spengono
     # mai. Best-effort: se la lettura fallisce, non spegniamo nulla (fail-open).
@@ -6001,7 +6352,10 @@ def _briefing_raccogli_notifiche(
     if ristorante_id:
         try:
             from services.daily_briefing_service import espandi_topic_spenti
-            _pref = _get_assistant_preferences(ristorante_id, supabase_client)
+            _pref = (
+                contesto.preferenze() if contesto is not None
+                else _get_assistant_preferences(ristorante_id, supabase_client)
+            )
             spenti = {
                 t for t in espandi_topic_spenti(_pref.get("topics_disabled"))
                 if t not in _CONFIG_TOPICS_BLOCCATI
@@ -6015,18 +6369,11 @@ def _briefing_raccogli_notifiche(
     # persistite di un'altra sede dello stesso cliente multi-sede.
     notifications: List[Dict[str, Any]] = []
     try:
-        q = (
-            supabase_client.table("notification_inbox")
-            .select("id,topic_key,source_type,severity,title,body,action_page,payload,dismissed_at,expires_at,created_at,source_event_at,dedupe_key")
-            .eq("user_id", user_id)
-            .or_("expires_at.is.null,expires_at.gt." + _dt.now(_tz.utc).isoformat())
-            .order("created_at", desc=True)
-            .limit(100)
-        )
-        if ristorante_id:
-            q = q.eq("ristorante_id", ristorante_id)
-        resp = q.execute()
-        notifications = [r for r in (resp.data or []) if not r.get("dismissed_at")]
+        if contesto is not None:
+            righe_inbox = contesto.inbox()
+        else:
+            righe_inbox = _leggi_notification_inbox(user_id, ristorante_id, supabase_client)
+        notifications = [dict(r) for r in righe_inbox if not r.get("dismissed_at")]
     except Exception as exc:
         logger.warning("home_briefing: lettura notifiche fallita: %s", exc)
 
@@ -6318,21 +6665,29 @@ def home_briefing(
     authorization: Optional[str] = Header(None),
 ) -> BriefingResponse:
     from services import get_supabase_client
+
+    user = _resolve_user_from_token(authorization)
+    supabase_client = get_supabase_client()
+    ctx = _HomeContesto(user, supabase_client, _resolve_ristorante_id(user, supabase_client))
+    return _home_briefing_calcola(ctx, background_tasks)
+
+
+def _home_briefing_calcola(ctx: _HomeContesto, background_tasks: BackgroundTasks) -> BriefingResponse:
+    """Corpo di /api/home/briefing sul contesto Home (utente e sede gia' risolti)."""
     from services.daily_briefing_service import (
         get_today_briefing,
         snapshot_is_stale,
         _build_snapshot,
     )
 
-    user = _resolve_user_from_token(authorization)
-    user_id = str(user["id"])
+    user_id = ctx.user_id
     # Saluto Home AI: SOLO il nome_referente scelto nel configuratore. Se manca,
     # saluto liscio ("Buongiorno") — mai la ragione sociale, che e' brutta da
     # leggere ("LAND DEI SAPORI SRL") e poco umana.
-    nome = user.get("nome_referente")
+    nome = ctx.user.get("nome_referente")
 
-    supabase_client = get_supabase_client()
-    ristorante_id = _resolve_ristorante_id(user, supabase_client)
+    supabase_client = ctx.sb
+    ristorante_id = ctx.ristorante_id
 
     # ── Fast-path 1: cache-first di OGGI (solo se FRESCO) ────────────────────
     # Il briefing e' un dato GIORNALIERO: se lo snapshot di oggi esiste gia' in
@@ -6344,7 +6699,7 @@ def home_briefing(
     if ristorante_id:
         cached_today = get_today_briefing(user_id, ristorante_id, supabase_client)
         if cached_today is not None and not snapshot_is_stale(cached_today):
-            nome, _ = _briefing_nome_referente(nome, ristorante_id, supabase_client)
+            nome, _ = _briefing_nome_referente(nome, ristorante_id, supabase_client, ctx.preferenze())
             return _briefing_response_from_snapshot(cached_today, nome)
 
     # ── Fast-path 2: "mai bloccante" MA coerente ─────────────────────────────
@@ -6358,7 +6713,7 @@ def home_briefing(
     # con TUTTI i segnali live tranne l'alert prezzi (l'unica parte da 4s) e senza
     # riscrittura AI: istantaneo E coerente con la card Salute. Il tono AI + alert
     # prezzi arrivano col load successivo (fast-path 1) dalla rigenerazione async.
-    nome, topics_disabled = _briefing_nome_referente(nome, ristorante_id, supabase_client)
+    nome, topics_disabled = _briefing_nome_referente(nome, ristorante_id, supabase_client, ctx.preferenze())
 
     if ristorante_id:
         background_tasks.add_task(_briefing_rigenera_async, user_id, ristorante_id)
@@ -6366,6 +6721,7 @@ def home_briefing(
         try:
             notifications = _briefing_raccogli_notifiche(
                 user_id, ristorante_id, supabase_client, includi_alert_prezzi=False,
+                contesto=ctx,
             )
         except Exception as exc:
             logger.warning("home_briefing: raccolta istantanea fallita: %s", exc)
@@ -6408,13 +6764,17 @@ def home_salute(authorization: Optional[str] = Header(None)) -> SaluteResponse:
     giorno 1 del mese l'indice non si azzera di colpo. Tutti i calcoli qui nel
     backend; la Home si limita a mostrare.
     """
+    user = _resolve_user_from_token(authorization)
+    sb = _get_supabase_client()
+    return _home_salute_calcola(_HomeContesto(user, sb, _resolve_ristorante_id(user, sb)))
+
+
+def _home_salute_calcola(ctx: _HomeContesto) -> SaluteResponse:
+    """Corpo di /api/home/salute sul contesto Home (utente e sede gia' risolti)."""
     from datetime import datetime as _dt, timedelta as _td
 
-    try:
-        from zoneinfo import ZoneInfo
-        oggi = _dt.now(tz=ZoneInfo("Europe/Rome")).date()
-    except Exception:
-        oggi = _dt.now().date()
+    # Stesso "oggi" della card KPI: nel bundle leggono le stesse righe del mese.
+    oggi = _oggi_rome()
     inizio = oggi - _td(days=29)  # finestra mobile di 30 giorni inclusivi
     data_da = inizio.isoformat()
     data_a = oggi.isoformat()
@@ -6438,10 +6798,8 @@ def home_salute(authorization: Optional[str] = Header(None)) -> SaluteResponse:
     primo_mese_corrente = _dt(oggi.year, oggi.month, 1).date()
     mc_a = (primo_mese_corrente - _td(days=1)).isoformat()
 
-    user = _resolve_user_from_token(authorization)
-    user_id = str(user["id"])
-    sb = _get_supabase_client()
-    ristorante_id = _resolve_ristorante_id(user, sb)
+    sb = ctx.sb
+    ristorante_id = ctx.ristorante_id
 
     # Senza ristorante non possiamo misurare: indice 0, tutto da fare.
     if not ristorante_id:
@@ -6464,7 +6822,7 @@ def home_salute(authorization: Optional[str] = Header(None)) -> SaluteResponse:
     voci_spente: set = set()
     try:
         from services.daily_briefing_service import espandi_topic_spenti
-        _, _td_salute = _briefing_nome_referente(None, ristorante_id, sb)
+        _, _td_salute = _briefing_nome_referente(None, ristorante_id, sb, ctx.preferenze())
         spenti = set(espandi_topic_spenti(_td_salute or []))
         voci_spente = {k for k, t in _VOCE_TOPIC.items() if t in spenti}
     except Exception as exc:
@@ -6494,8 +6852,14 @@ def home_salute(authorization: Optional[str] = Header(None)) -> SaluteResponse:
     # fatture DEL MESE di cui parliamo sono arrivate (stessa fonte RPC del KPI),
     # non un caricamento recente qualsiasi. Cosi' una sede con maggio a food cost
     # 0% vede la voce ROSSA, non un falso verde da fatture di marzo caricate ieri.
-    # Se la fonte RPC non e' disponibile, ripiego sul caricamento recente.
-    costi_mese = _costi_automatici_mese(ristorante_id, mc_anno, mc_mese, sb, user_id)
+    # Se la fonte RPC non e' disponibile, ripiego sul caricamento recente. Gli
+    # stessi costi dell'anno servono alla card KPI: nel bundle li legge una volta.
+    try:
+        _cfb, _csp = ctx.costi_automatici_anno(mc_anno)
+        costi_mese: Optional[float] = float(_cfb.get(mc_mese) or 0) + float(_csp.get(mc_mese) or 0)
+    except Exception as exc:
+        logger.warning("home_salute: costi automatici del mese falliti: %s", exc)
+        costi_mese = None
     if costi_mese is None:
         fatture_ok = len(righe_mese) > 0
         fatture_dett = ("Fatture recenti registrate" if fatture_ok
@@ -6506,34 +6870,20 @@ def home_salute(authorization: Optional[str] = Header(None)) -> SaluteResponse:
                         else f"Mancano le fatture di {mese_completo_label}")
 
     # ── Voci 2 e 3: Fatturato + Costo personale dell'ultimo mese completo ──
-    # Unica query su margini_mensili (stessa fonte delle card "manca fatturato/
-    # personale" e del KPI): prima erano due round-trip separati sullo STESSO
-    # mese, ricaviamo entrambe le voci dalle stesse righe. I ricavi giornalieri
-    # non sono usati dai clienti, sarebbe sempre "manca".
+    # Stessa riga margini_mensili del KPI (l'anno intero lo carica il contesto,
+    # una volta per entrambe le card): ricaviamo le due voci dalla riga del mese.
+    # I ricavi giornalieri non sono usati dai clienti, sarebbe sempre "manca".
     fatturato_ok = False
     personale_ok = False
     try:
-        resp = (
-            sb.table("margini_mensili")
-            .select(
-                "fatturato_iva10,fatturato_iva22,altri_ricavi_noiva,"
-                "costo_dipendenti,costo_personale_extra"
-            )
-            .eq("ristorante_id", ristorante_id)
-            .eq("anno", mc_anno)
-            .eq("mese", mc_mese)
-            .execute()
+        r = ctx.margini_anno(mc_anno).get(mc_mese) or {}
+        netto = (
+            float(r.get("fatturato_iva10") or 0)
+            + float(r.get("fatturato_iva22") or 0)
+            + float(r.get("altri_ricavi_noiva") or 0)
         )
-        netto = 0.0
-        for r in (resp.data or []):
-            netto += (
-                float(r.get("fatturato_iva10") or 0)
-                + float(r.get("fatturato_iva22") or 0)
-                + float(r.get("altri_ricavi_noiva") or 0)
-            )
-            if (float(r.get("costo_dipendenti") or 0)
-                    + float(r.get("costo_personale_extra") or 0)) > 0:
-                personale_ok = True
+        personale_ok = (float(r.get("costo_dipendenti") or 0)
+                        + float(r.get("costo_personale_extra") or 0)) > 0
         fatturato_ok = netto > 0
     except Exception as exc:
         logger.warning("home_salute: lettura fatturato/personale margini fallita: %s", exc)
@@ -6546,7 +6896,7 @@ def home_salute(authorization: Optional[str] = Header(None)) -> SaluteResponse:
     # _briefing_dati_mensili_mancanti -> card e briefing restano coerenti.
     if not fatturato_ok:
         try:
-            ov = _load_mensile_overrides(sb, ristorante_id, [mc_anno]).get((mc_anno, mc_mese))
+            ov = ctx.override_mensili(mc_anno).get((mc_anno, mc_mese))
             if ov and (ov.get("iva10", 0) + ov.get("iva22", 0) + ov.get("altri", 0)) > 0:
                 fatturato_ok = True
         except Exception as exc:
@@ -6660,17 +7010,20 @@ def home_alert_prezzi(authorization: Optional[str] = Header(None)) -> AlertPrezz
     food del periodo), monitora prodotti e custom tag. Tutto calcolato nel
     backend (price_impact_service); la Home si limita a mostrare.
     """
-    from services.price_impact_service import calcola_alert_prezzi_impatto
-
     user = _resolve_user_from_token(authorization)
-    user_id = str(user["id"])
     sb = _get_supabase_client()
-    ristorante_id = _resolve_ristorante_id(user, sb)
-    if not ristorante_id:
+    return _home_alert_prezzi_calcola(_HomeContesto(user, sb, _resolve_ristorante_id(user, sb)))
+
+
+def _home_alert_prezzi_calcola(ctx: _HomeContesto) -> AlertPrezziResponse:
+    """Corpo di /api/home/alert-prezzi sul contesto Home."""
+    from services.price_impact_service import calcola_alert_prezzi_impatto
+
+    if not ctx.ristorante_id:
         return AlertPrezziResponse(count=0, alerts=[], top=None)
 
     try:
-        res = calcola_alert_prezzi_impatto(user_id, ristorante_id, supabase_client=sb)
+        res = calcola_alert_prezzi_impatto(ctx.user_id, ctx.ristorante_id, supabase_client=ctx.sb)
     except Exception as exc:
         logger.warning("home_alert_prezzi: calcolo fallito: %s", exc)
         return AlertPrezziResponse(count=0, alerts=[], top=None)
@@ -6684,33 +7037,69 @@ def home_alert_prezzi(authorization: Optional[str] = Header(None)) -> AlertPrezz
     )
 
 
+# Versione in-process dei dati di ogni sede: sale a ogni invalidazione KPI o
+# righe fatture (locale o arrivata dagli altri processi via cache_bus), cioe'
+# a ogni scrittura che cambia i conti della sede. Le viste di catena la usano
+# come parte della chiave del loro snapshot (routers/gruppo): una scrittura su
+# una sede cambia la chiave e lo snapshot vecchio non viene piu' letto, senza
+# dover sapere quali catene contengono quella sede. "*" = invalidazione globale.
+_VERSIONE_DATI_SEDE: Dict[str, int] = {}
+_VERSIONE_DATI_LOCK = threading.Lock()
+
+
+def _incrementa_versione_dati(ristorante_id: Optional[str]) -> None:
+    chiave = "*" if ristorante_id is None else str(ristorante_id)
+    with _VERSIONE_DATI_LOCK:
+        _VERSIONE_DATI_SEDE[chiave] = _VERSIONE_DATI_SEDE.get(chiave, 0) + 1
+
+
+def _versione_dati_sedi(ristorante_ids: List[str]) -> tuple:
+    """Versione dei dati di un insieme di sedi (per chiavi di cache di catena)."""
+    with _VERSIONE_DATI_LOCK:
+        return (_VERSIONE_DATI_SEDE.get("*", 0),) + tuple(
+            _VERSIONE_DATI_SEDE.get(str(rid), 0) for rid in ristorante_ids
+        )
+
+
 # Cache in-memoria dei KPI Home: i conti cambiano lentamente, un TTL breve
 # abbatte il carico (query + aggregazioni) anche con centinaia di clienti che
 # riaprono la Home. Niente tabella DB: sopravvive senza migration, e al massimo
 # si perde al redeploy (ricalcolo trasparente). Chiave = "{ristorante}:{anno}:{mese}".
-_HOME_KPI_CACHE: Dict[str, tuple] = {}
-_HOME_KPI_TTL = 120.0  # secondi
+# Le scritture che la toccano la invalidano in tutti i processi (cache_bus).
+_HOME_KPI_TTL = 300.0  # secondi
+_HOME_KPI_CACHE = TTLCache(ttl=_HOME_KPI_TTL, nome="home_kpi", max_entries=2000)
 
 
-def _invalidate_home_kpi_cache(ristorante_id: Optional[str] = None) -> None:
+def _invalidate_home_kpi_cache(ristorante_id: Optional[str] = None, *, propaga: bool = True) -> None:
     """Invalida la cache KPI Home (tutto, o solo un ristorante).
 
     Va chiamata quando cambiano i dati che alimentano i KPI (inserimento
     fatturato/personale/centri, upload fatture): senza questo la card "I tuoi
-    conti" restava ferma fino al TTL (2 min) mostrando numeri stantii anche dopo
+    conti" restava ferma fino al TTL mostrando numeri stantii anche dopo
     l'inserimento — l'utente vedeva il briefing aggiornarsi ma il MOL no. La
     chiave include anno:mese, quindi per un singolo ristorante togliamo tutte le
     sue entry (mese mostrato + eventuali mesi vicini precaricati nel fallback).
+
+    Con `propaga` l'invalidazione arriva anche agli altri processi (cache_bus):
+    anche al processo web quando scrive il queue-worker.
     """
+    if propaga:
+        cache_bus.pubblica("home_kpi", ristorante_id)
+    _incrementa_versione_dati(ristorante_id)
     if ristorante_id is None:
-        _HOME_KPI_CACHE.clear()
+        _HOME_KPI_CACHE.invalidate()
         return
     prefisso = f"{ristorante_id}:"
-    for k in [k for k in _HOME_KPI_CACHE if k.startswith(prefisso)]:
-        _HOME_KPI_CACHE.pop(k, None)
+    _HOME_KPI_CACHE.invalidate_where(lambda k: k.startswith(prefisso))
+
 
+cache_bus.registra("home_kpi", lambda rid: _invalidate_home_kpi_cache(rid, propaga=False))
 
-def _merge_override_mensile(margini_anno: dict, sb, ristorante_id: str, anno: int) -> dict:
+
+def _merge_override_mensile(
+    margini_anno: dict, sb, ristorante_id: str, anno: int,
+    ovs: Optional[Dict[tuple, Dict[str, float]]] = None,
+) -> dict:
     """Sovrappone alle righe margini_mensili il fatturato della modalità 'mensile'.
 
     Alcuni clienti inseriscono il fatturato come totale del mese: vive in
@@ -6718,12 +7107,14 @@ def _merge_override_mensile(margini_anno: dict, sb, ristorante_id: str, anno: in
     La pagina Margini (get_margini_analisi) fonde questa fonte; qui facciamo lo
     stesso, così la card KPI e la pagina Margini mostrano gli stessi numeri (caso
     CASATI 14). Best-effort: se la lettura override fallisce, margini invariati.
+    `ovs` gia' letti (contesto Home) evitano la query.
     """
-    try:
-        ovs = _load_mensile_overrides(sb, ristorante_id, [anno])
-    except Exception as exc:
-        logger.warning("merge override mensile fallito: %s", exc)
-        return margini_anno
+    if ovs is None:
+        try:
+            ovs = _load_mensile_overrides(sb, ristorante_id, [anno])
+        except Exception as exc:
+            logger.warning("merge override mensile fallito: %s", exc)
+            return margini_anno
     for (a, m), ov in ovs.items():
         if a != anno:
             continue
@@ -6804,9 +7195,13 @@ def home_kpi(authorization: Optional[str] = Header(None)) -> HomeKpiResponse:
     food/spese dalle fatture. E' l'unica fonte affidabile: nessun cliente usa i
     ricavi giornalieri. Confronto vs il mese precedente (frecce ↑↓).
     """
-    import time as _time
-    from datetime import date as _date
+    user = _resolve_user_from_token(authorization)
+    sb = _get_supabase_client()
+    return _home_kpi_calcola(_HomeContesto(user, sb, _resolve_ristorante_id(user, sb)))
+
 
+def _home_kpi_calcola(ctx: _HomeContesto) -> HomeKpiResponse:
+    """Corpo di /api/home/kpi sul contesto Home (utente e sede gia' risolti)."""
     _MESI_IT = [
         "", "Gennaio", "Febbraio", "Marzo", "Aprile", "Maggio", "Giugno",
         "Luglio", "Agosto", "Settembre", "Ottobre", "Novembre", "Dicembre",
@@ -6817,36 +7212,31 @@ def home_kpi(authorization: Optional[str] = Header(None)) -> HomeKpiResponse:
         mol=0.0, has_data=False,
     )
 
-    user = _resolve_user_from_token(authorization)
-    user_id = str(user["id"])
-    sb = _get_supabase_client()
-    ristorante_id = _resolve_ristorante_id(user, sb)
+    ristorante_id = ctx.ristorante_id
     if not ristorante_id:
         return _vuoto
 
     oggi = _oggi_rome()
     cache_key = f"{ristorante_id}:{oggi.year}:{oggi.month}"
     cached = _HOME_KPI_CACHE.get(cache_key)
-    if cached and (_time.monotonic() - cached[0]) < _HOME_KPI_TTL:
-        return cached[1]
-
-    from services.margine_service import (
-        carica_margini_anno,
-        calcola_costi_automatici_per_anno_sql,
-    )
+    if cached is not None:
+        return cached
 
     def _dati_anno(anno: int):
         try:
-            m = carica_margini_anno(user_id, ristorante_id, anno)
+            # Copia: le righe del contesto le legge anche la card Salute.
+            m = dict(ctx.margini_anno(anno))
             # Fonde il fatturato della modalità mensile (ricavi_modalita_mensile),
             # come la pagina Margini: senza, i mesi in modalità mensile uscirebbero
             # a fatturato 0 e MOL sbagliato (caso CASATI 14).
-            m = _merge_override_mensile(m, sb, ristorante_id, anno)
+            m = _merge_override_mensile(
+                m, ctx.sb, ristorante_id, anno, ovs=ctx.override_mensili(anno),
+            )
             # Variante SQL (RPC): aggrega i costi food/spese lato DB invece del
             # full-load + pandas. home_kpi puo' toccare 2 anni (mostrato + confronto)
             # -> evita 2 full-load di tutte le righe fattura. Ha fallback pandas
             # interno, quindi non puo' rompersi.
-            fb, sp = calcola_costi_automatici_per_anno_sql(user_id, ristorante_id, anno)
+            fb, sp = ctx.costi_automatici_anno(anno)
             return m, fb, sp
         except Exception as exc:
             logger.warning("home_kpi: caricamento anno %s fallito: %s", anno, exc)
@@ -6962,17 +7352,77 @@ def home_kpi(authorization: Optional[str] = Header(None)) -> HomeKpiResponse:
         mol_mensile=mol_mensile,
         mol_mensile_anno=anno_usato if mol_mensile else None,
     )
-    # Eviction opportunistica delle entry scadute: la chiave include anno:mese,
-    # quindi col passare dei giorni si accumulerebbero chiavi morte mai rimosse
-    # (la cache cresceva senza limite). Pulendo ad ogni miss restano solo le
-    # entry vive — costo trascurabile (poche chiavi per cliente).
-    now = _time.monotonic()
-    for k in [k for k, v in _HOME_KPI_CACHE.items() if (now - v[0]) >= _HOME_KPI_TTL]:
-        _HOME_KPI_CACHE.pop(k, None)
-    _HOME_KPI_CACHE[cache_key] = (now, resp)
+    # La chiave include anno:mese: le chiavi dei mesi passati le toglie lo sweep
+    # delle scadute di utils/ttl_cache (prima: giro su tutta la cache a ogni miss).
+    _HOME_KPI_CACHE.set(cache_key, resp)
     return resp
 
 
+_HOME_BUNDLE_CARD = ("stats", "kpi", "briefing", "salute", "alert_prezzi", "notifiche")
+
+
+@app.get(
+    "/api/home/bundle",
+    response_model=HomeBundleResponse,
+    summary="Home in una chiamata — stats, KPI, briefing, salute, alert prezzi, notifiche",
+    tags=["Home"],
+    dependencies=[Depends(_verify_worker_key)],
+)
+async def home_bundle(
+    background_tasks: BackgroundTasks,
+    authorization: Optional[str] = Header(None),
+    card: Optional[List[str]] = Query(None),
+) -> HomeBundleResponse:
+    """Le card della Home calcolate insieme su un solo contesto.
+
+    Prima la Home chiamava 6 endpoint in parallelo: 6 verifiche del token, 6
+    risoluzioni della sede e letture ripetute delle stesse tabelle (preferenze,
+    notification_inbox, margini_mensili, override mensili, costi dell'anno).
+    Qui token e sede si risolvono una volta e le card girano in parallelo su un
+    _HomeContesto condiviso, che fa ogni lettura comune una volta sola. Gli
+    endpoint delle singole card restano, come viste sullo stesso codice.
+
+    `card` (ripetibile) limita il calcolo alle card indicate; default tutte.
+    Una card che fallisce torna None senza affossare le altre. L'alert prezzi
+    ha il budget del briefing (_ALERT_PREZZI_TIMEOUT_SEC): oltre, None e il
+    calcolo finisce in background.
+    """
+    richieste = list(dict.fromkeys(card or _HOME_BUNDLE_CARD))
+    sconosciute = [c for c in richieste if c not in _HOME_BUNDLE_CARD]
+    if sconosciute:
+        raise HTTPException(status_code=400, detail=f"Card sconosciute: {', '.join(sconosciute)}")
+
+    user = await _resolve_user_from_token_async(authorization)
+    asb = _get_async_supabase_client()
+    ristorante_id = await _resolve_ristorante_id_async(user, asb)
+    ctx = _HomeContesto(user, _get_supabase_client(), ristorante_id)
+
+    async def _alert_prezzi():
+        fut = _ALERT_PREZZI_EXECUTOR.submit(_home_alert_prezzi_calcola, ctx)
+        return await asyncio.wait_for(asyncio.wrap_future(fut), timeout=_ALERT_PREZZI_TIMEOUT_SEC)
+
+    calcoli = {
+        "stats": lambda: _dashboard_stats_calcola(asb, ctx.user_id, ristorante_id),
+        "kpi": lambda: run_in_threadpool(_home_kpi_calcola, ctx),
+        "briefing": lambda: run_in_threadpool(_home_briefing_calcola, ctx, background_tasks),
+        "salute": lambda: run_in_threadpool(_home_salute_calcola, ctx),
+        "alert_prezzi": _alert_prezzi,
+        "notifiche": lambda: run_in_threadpool(_notifiche_calcola, ctx),
+    }
+    esiti = await asyncio.gather(*(calcoli[c]() for c in richieste), return_exceptions=True)
+
+    out: Dict[str, Any] = {}
+    for nome, esito in zip(richieste, esiti):
+        if isinstance(esito, asyncio.TimeoutError):
+            logger.warning("home_bundle: %s oltre %ss per ristorante=%s — omessa",
+                           nome, _ALERT_PREZZI_TIMEOUT_SEC, ristorante_id)
+        elif isinstance(esito, Exception):
+            logger.warning("home_bundle: card %s fallita: %s", nome, esito)
+        else:
+            out[nome] = esito
+    return HomeBundleResponse(**out)
+
+
 @app.get(
     "/api/home/config",
     response_model=ConfigResponse,
@@ -7114,7 +7564,7 @@ def home_config_post(
     # segnali live mostrati: invalida entrambe le cache cosi' la Home riflette
     # subito il cambiamento invece di aspettare il TTL.
     _invalidate_assist_pref_cache(ristorante_id)
-    _LIVE_SEGNALI_CACHE.pop(ristorante_id, None)
+    _LIVE_SEGNALI_CACHE.invalidate(ristorante_id)
 
     # Cambiare quali prodotti generano avvisi (preferiti vs Pareto), i giorni di
     # chiusura (tolleranza ricavi automatici) o QUALI TOPIC sono spenti cambia il
@@ -7327,30 +7777,25 @@ def _build_fatture_base_query(supabase_client, ristorante_id: str):
     )
 
 
-def _apply_tipo_prodotti_filter(rows: List[Dict[str, Any]], tipo: Optional[str]) -> List[Dict[str, Any]]:
-    """Filtra le righe per tipo prodotti: food_beverage / spese_generali / tutti."""
-    if not tipo or tipo == "tutti":
-        return rows
-    if tipo == "food_beverage":
-        return [r for r in rows if (r.get("categoria") or "") not in CATEGORIE_SPESE_GENERALI_WORKER]
-    if tipo == "spese_generali":
-        return [r for r in rows if (r.get("categoria") or "") in CATEGORIE_SPESE_GENERALI_WORKER]
-    return rows
-
-
 def _exclude_note_rows(rows: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
     return [r for r in rows if (r.get("categoria") or "") not in CATEGORIE_NOTE_WORKER]
 
 
-_FATTURE_ROWS_CACHE: Dict[str, tuple] = {}  # key -> (expires_at, rows)
-# TTL corto: abbatte i 4 full-scan dello STESSO caricamento pagina (che avvengono
-# in pochi secondi) senza tenere dati stale a lungo dopo una modifica categoria/
-# cestino dell'utente. Invalidazione esplicita su upload + cambio categoria singolo;
-# per gli altri update (batch/cestino) ci si affida al TTL corto.
-_FATTURE_ROWS_TTL = 15.0  # secondi
+# Abbatte i 4 full-scan dello STESSO caricamento pagina e le riletture delle
+# pagine successive. Invalidazione esplicita su upload, cambio categoria (singolo
+# e batch), cestino, riparto e spostamento sede, propagata agli altri processi da
+# services/cache_bus: il TTL resta solo come rete di sicurezza (era 15s quando
+# l'invalidazione valeva per il solo processo che scriveva).
+_FATTURE_ROWS_TTL = 120.0  # secondi
+# Tetto in byte (stima di RigheColonnari.nbytes): sono le voci piu' pesanti del
+# processo, un periodo lungo di un cliente grande vale decine di MB.
+_FATTURE_ROWS_MAX_BYTES = int(float(os.getenv("WORKER_CACHE_RIGHE_MAX_MB", "256")) * 1024 * 1024)
+_FATTURE_ROWS_CACHE = TTLCache(  # "rid::da::a" -> RigheColonnari
+    ttl=_FATTURE_ROWS_TTL, nome="fatture_righe", max_entries=256, max_bytes=_FATTURE_ROWS_MAX_BYTES,
+)
 
 
-def _invalidate_fatture_rows_cache(ristorante_id: Optional[str] = None) -> None:
+def _invalidate_fatture_rows_cache(ristorante_id: Optional[str] = None, *, propaga: bool = True) -> None:
     """Invalida la cache righe fatture (tutto, o solo un ristorante).
 
     Invalida anche la cache righe del router PREZZI: legge le stesse righe della
@@ -7364,23 +7809,34 @@ def _invalidate_fatture_rows_cache(ristorante_id: Optional[str] = None) -> None:
     una riga non cambiava il numero mostrato in Home finche' non scadeva il TTL:
     il cliente vedeva ancora "70 da controllare" con 17 reali rimaste, e nemmeno
     il refresh aiutava (rileggeva la stessa cache stantia).
+
+    Con `propaga` (default) l'evento va anche agli altri processi via
+    services/cache_bus, che lo applicano con propaga=False: solo la parte
+    in-memoria, lo snapshot briefing sta a DB ed e' gia' stato cancellato qui.
     """
+    _incrementa_versione_dati(ristorante_id)
     if ristorante_id is None:
-        _FATTURE_ROWS_CACHE.clear()
-        _RISTORANTE_QUOTE_META.clear()
+        _FATTURE_ROWS_CACHE.invalidate()
+        _RISTORANTE_QUOTE_CACHE.invalidate()
+        _DASHBOARD_STATS_CACHE.invalidate()
     else:
-        for k in [k for k in _FATTURE_ROWS_CACHE if k.startswith(f"{ristorante_id}::")]:
-            _FATTURE_ROWS_CACHE.pop(k, None)
-        _RISTORANTE_QUOTE_META.pop(ristorante_id, None)
+        _FATTURE_ROWS_CACHE.invalidate_where(lambda k: k.startswith(f"{ristorante_id}::"))
+        _RISTORANTE_QUOTE_CACHE.invalidate(ristorante_id)
+        # Chiave "dashstats:{user}:{ristorante}": le stesse righe, aggregate.
+        _DASHBOARD_STATS_CACHE.invalidate_where(lambda k: k.endswith(f":{ristorante_id}"))
 
     try:
         from services.routers.prezzi import _invalidate_prezzi_rows_cache
-        _invalidate_prezzi_rows_cache()
+        _invalidate_prezzi_rows_cache(ristorante_id)
     except Exception as exc:  # pragma: no cover - il router potrebbe non essere caricato
         # Loggato, non ingoiato: se un domani il modulo si rinomina, PREZZI
         # resterebbe con dati stale e senza questo warning nessuno lo scoprirebbe.
         logger.warning("invalidazione cache prezzi fallita: %s", exc)
 
+    if not propaga:
+        return
+    cache_bus.pubblica("fatture", ristorante_id)
+
     if ristorante_id is not None:
         try:
             from services.daily_briefing_service import _today_rome
@@ -7394,18 +7850,20 @@ def _invalidate_fatture_rows_cache(ristorante_id: Optional[str] = None) -> None:
 # Cache (ristorante_id -> (user_id, ha_quote_ripartite)) per decidere se un PV va
 # arricchito con le righe di gruppo proiettate. TTL lungo: l'anagrafica sede e
 # l'essere-o-no PV di catena cambiano di rado. Invalidata insieme alle righe.
-_RISTORANTE_QUOTE_META: Dict[str, tuple] = {}  # rid -> (expires_at, user_id, ha_quote)
 _RISTORANTE_QUOTE_TTL = 300.0  # secondi
+_RISTORANTE_QUOTE_CACHE = TTLCache(  # rid -> (user_id, ha_quote)
+    ttl=_RISTORANTE_QUOTE_TTL, nome="ristorante_quote", max_entries=5000,
+)
+
+cache_bus.registra("fatture", lambda rid: _invalidate_fatture_rows_cache(rid, propaga=False))
 
 
 def _ristorante_quote_meta(supabase_client, ristorante_id: str) -> tuple:
     """(user_id, ha_quote_ripartite) per un ristorante. Un PV è "di catena" ai fini
     della proiezione se esiste almeno una quota riparto a suo carico."""
-    import time as _time
-    _now = _time.time()
-    cached = _RISTORANTE_QUOTE_META.get(ristorante_id)
-    if cached is not None and cached[0] > _now:
-        return cached[1], cached[2]
+    cached = _RISTORANTE_QUOTE_CACHE.get(ristorante_id)
+    if cached is not None:
+        return cached
     user_id = None
     ha_quote = False
     try:
@@ -7431,88 +7889,106 @@ def _ristorante_quote_meta(supabase_client, ristorante_id: str) -> tuple:
             ha_quote = bool(q.data)
         except Exception:
             ha_quote = False
-    _RISTORANTE_QUOTE_META[ristorante_id] = (_now + _RISTORANTE_QUOTE_TTL, user_id, ha_quote)
+    _RISTORANTE_QUOTE_CACHE.set(ristorante_id, (user_id, ha_quote))
     return user_id, ha_quote
 
 
-def _fetch_fatture_rows(
+def _righe_fatture_periodo(
     supabase_client,
     ristorante_id: str,
-    data_da: Optional[str] = None,
-    data_a: Optional[str] = None,
-    tipo_prodotti: Optional[str] = None,
-    search: Optional[str] = None,
-) -> List[Dict[str, Any]]:
-    """Recupera righe fattura filtrate con paginazione interna per superare il limite Supabase di 1000.
+    data_da: Optional[str],
+    data_a: Optional[str],
+) -> RigheColonnari:
+    """Tutte le righe del periodo (senza note, con le proiettate di gruppo), in cache.
 
-    Cache TTL in-process (90s) chiavata sui parametri: aprire un tab faceva 4
+    Cache TTL in-process chiavata sul solo periodo: aprire un tab faceva 4
     scansioni complete della tabella (KPI corrente+precedente, articoli+pivot)
-    senza riuso. App di analisi non-critica -> un ritardo di 90s e' accettabile.
+    senza riuso, e ogni combinazione search/tipo_prodotti ne teneva una copia.
+    Le righe sono in forma colonnare (utils/righe_colonnari): ~10x meno RSS dei
+    dict, e i filtri si applicano sopra come maschere.
     Invalidata su upload via _invalidate_fatture_rows_cache.
     """
-    import time as _time
-    cache_key = f"{ristorante_id}::{data_da}::{data_a}::{tipo_prodotti}::{search}"
-    _now = _time.time()
+    cache_key = f"{ristorante_id}::{data_da}::{data_a}"
     _cached = _FATTURE_ROWS_CACHE.get(cache_key)
-    if _cached is not None and _cached[0] > _now:
-        return _cached[1]
+    if _cached is not None:
+        return _cached
 
-    all_rows: List[Dict[str, Any]] = []
-    page_size = 1000
-    offset = 0
-    while True:
+    def _query():
+        # Una query nuova per pagina: il builder di supabase-py e' mutabile.
         q = _build_fatture_base_query(supabase_client, ristorante_id)
         if data_da:
             q = q.gte("data_documento", data_da)
         if data_a:
             q = q.lte("data_documento", data_a)
-        if search:
-            term = _sanitize_postgrest_term(search)
-            if term:
-                # cerca trasversalmente in descrizione, fornitore, categoria
-                q = q.or_(
-                    f"descrizione.ilike.%{term}%,fornitore.ilike.%{term}%,categoria.ilike.%{term}%"
-                )
-        q = q.order("data_documento", desc=True).order("id", desc=True)
-        res = q.range(offset, offset + page_size - 1).execute()
-        batch = res.data or []
-        all_rows.extend(batch)
-        if len(batch) < page_size:
-            break
-        offset += page_size
-        if offset >= 50000:  # safety cap
-            break
+        return q
+
+    # Keyset su id desc (stesso cap di 50000 righe e warning di troncamento):
+    # con l'offset un upload concorrente spostava le righe fra le pagine.
+    # data_documento e' nullable, quindi non puo' fare da cursore: l'ordine
+    # storico (data_documento desc NULLS FIRST come Postgres, poi id desc) si
+    # ricostruisce qui con un sort stabile.
+    all_rows: List[Dict[str, Any]] = fetch_all_keyset(_query, chiavi=(("id", True),))
+    all_rows.sort(key=lambda r: (r.get("data_documento") is None, r.get("data_documento") or ""),
+                  reverse=True)
 
     all_rows = _exclude_note_rows(all_rows)
 
     # Righe di gruppo proiettate (Lettura B): se questo ristorante è un PV di catena
     # con quote a suo carico, aggiungiamo le righe della sua quota sui costi di gruppo
     # — in sola lettura, senza toccare `fatture`. Da qui in poi si comportano come righe
-    # reali in ogni consumatore (aggregati, pivot, grafici, trend). Il search testuale è
-    # già applicato alle righe reali via query; per coerenza filtriamo anche le proiettate.
+    # reali in ogni consumatore (aggregati, pivot, grafici, trend), filtri compresi.
     _uid, _ha_quote = _ristorante_quote_meta(supabase_client, ristorante_id)
     if _ha_quote and _uid:
         try:
             from services.riparto_service import righe_ripartite_proiettate
-            proiettate = righe_ripartite_proiettate(
+            all_rows = all_rows + righe_ripartite_proiettate(
                 supabase_client, str(_uid), ristorante_id, data_da, data_a
             )
-            if search:
-                term = (search or "").strip().lower()
-                if term:
-                    proiettate = [
-                        r for r in proiettate
-                        if term in (r.get("descrizione") or "").lower()
-                        or term in (r.get("fornitore") or "").lower()
-                        or term in (r.get("categoria") or "").lower()
-                    ]
-            all_rows = all_rows + proiettate
         except Exception:
             logger.exception("Proiezione righe ripartite fallita per %s", ristorante_id)
 
-    all_rows = _apply_tipo_prodotti_filter(all_rows, tipo_prodotti)
-    _FATTURE_ROWS_CACHE[cache_key] = (_now + _FATTURE_ROWS_TTL, all_rows)
-    return all_rows
+    righe = RigheColonnari.da_righe(all_rows)
+    _FATTURE_ROWS_CACHE.set(cache_key, righe)
+    return righe
+
+
+def _ilike_contiene(term: str):
+    """Predicato Python equivalente a `colonna ILIKE '%term%'` (% e _ jolly)."""
+    import re as _re
+    regex = "".join(".*" if c == "%" else "." if c == "_" else _re.escape(c) for c in term)
+    trova = _re.compile(regex, _re.IGNORECASE | _re.DOTALL).search
+    return lambda v: v is not None and trova(v) is not None
+
+
+def _fetch_fatture_rows(
+    supabase_client,
+    ristorante_id: str,
+    data_da: Optional[str] = None,
+    data_a: Optional[str] = None,
+    tipo_prodotti: Optional[str] = None,
+    search: Optional[str] = None,
+) -> List[Dict[str, Any]]:
+    """Righe fattura del periodo filtrate per tipo prodotti e testo (oltre il limite di 1000).
+
+    Il periodo arriva da `_righe_fatture_periodo` (una lettura per periodo);
+    tipo_prodotti e search sono maschere sulle colonne in cache, quindi cambiare
+    tab o cercare non torna su PostgREST. Le righe restituite sono dict nuovi.
+    """
+    righe = _righe_fatture_periodo(supabase_client, ristorante_id, data_da, data_a)
+    maschera = None
+    if tipo_prodotti == "food_beverage":
+        maschera = righe.maschera("categoria", lambda c: (c or "") not in CATEGORIE_SPESE_GENERALI_WORKER)
+    elif tipo_prodotti == "spese_generali":
+        maschera = righe.maschera("categoria", lambda c: (c or "") in CATEGORIE_SPESE_GENERALI_WORKER)
+    term = _sanitize_postgrest_term(search) if search else ""
+    if term:
+        # cerca trasversalmente in descrizione, fornitore, categoria (come l'ilike di prima)
+        contiene = _ilike_contiene(term)
+        trovate = (righe.maschera("descrizione", contiene)
+                   | righe.maschera("fornitore", contiene)
+                   | righe.maschera("categoria", contiene))
+        maschera = trovate if maschera is None else maschera & trovate
+    return righe.righe(maschera)
 
 
 # ═══════════════════════════════════════════════════════════════════════════
@@ -7578,17 +8054,50 @@ def _load_mensile_overrides(sb, ristorante_id: str, annos: List[int]) -> Dict[tu
         )
     except Exception:
         return {}
-    out: Dict[tuple, Dict[str, float]] = {}
-    for r in (resp.data or []):
-        out[(int(r["anno"]), int(r["mese"]))] = {
-            "iva10": float(r.get("fatturato_iva10") or 0),
-            "iva22": float(r.get("fatturato_iva22") or 0),
-            "altri": float(r.get("altri_ricavi_noiva") or 0),
-            "coperti": (int(r["coperti"]) if r.get("coperti") is not None else None),
-        }
+    return {(int(r["anno"]), int(r["mese"])): _override_mensile_da_riga(r) for r in (resp.data or [])}
+
+
+def _load_mensile_overrides_sedi(
+    sb, ristorante_ids: List[str], annos: List[int],
+) -> Dict[str, Dict[tuple, Dict[str, float]]]:
+    """Come _load_mensile_overrides ma per PIU' sedi in una query (viste di catena).
+
+    Ritorna {ristorante_id: {(anno,mese): {...}}}, con ogni sede presente (anche
+    senza mesi in modalita' mensile). Best-effort come la versione per sede.
+    """
+    ids = [str(r) for r in (ristorante_ids or [])]
+    out: Dict[str, Dict[tuple, Dict[str, float]]] = {rid: {} for rid in ids}
+    if not ids or not annos:
+        return out
+    try:
+        righe = fetch_all(
+            sb.table("ricavi_modalita_mensile")
+            .select("ristorante_id,anno,mese,modalita,fatturato_iva10,fatturato_iva22,altri_ricavi_noiva,coperti")
+            .in_("ristorante_id", ids)
+            .in_("anno", annos)
+            .eq("modalita", "mensile")
+            .order("ristorante_id")
+            .order("anno")
+            .order("mese")
+        )
+    except Exception:
+        return out
+    for r in righe:
+        rid = str(r.get("ristorante_id"))
+        if rid in out:
+            out[rid][(int(r["anno"]), int(r["mese"]))] = _override_mensile_da_riga(r)
     return out
 
 
+def _override_mensile_da_riga(r: Dict[str, Any]) -> Dict[str, float]:
+    return {
+        "iva10": float(r.get("fatturato_iva10") or 0),
+        "iva22": float(r.get("fatturato_iva22") or 0),
+        "altri": float(r.get("altri_ricavi_noiva") or 0),
+        "coperti": (int(r["coperti"]) if r.get("coperti") is not None else None),
+    }
+
+
 def _righe_quote_gruppo(sb, ristorante_id: str, data_da: str, data_a: str) -> List[Dict[str, Any]]:
     """Righe proiettate della quota costi di gruppo a carico di questo PV (catena).
 
@@ -7618,44 +8127,97 @@ def _righe_quote_gruppo(sb, ristorante_id: str, data_da: str, data_a: str) -> Li
 def _load_fatture_fb_for_period(
     sb, ristorante_id: str, data_da: str, data_a: str
 ) -> "Dict[str, float]":
-    import pandas as pd
-    page_size = 1000
-    all_rows: List[Dict[str, Any]] = []
-    offset = 0
-    while True:
-        q = (
-            sb.table("fatture")
-            .select("data_documento,totale_riga,categoria")
-            .eq("ristorante_id", ristorante_id)
-            .is_("deleted_at", "null")
-            .neq("categoria", "Da Classificare")
-            # Le fatture ripartite sul gruppo arrivano gia' come quote_riparto_*
-            # sui singoli PV: contarle anche qui sulla sede tecnica sarebbe doppio
-            # conteggio. Stesso filtro di _calcola_costi_auto_per_mese/_per_periodo.
-            .neq("ripartita_su_gruppo", True)
-            .gte("data_documento", data_da)
-            .lte("data_documento", data_a)
-            .range(offset, offset + page_size - 1)
-            .execute()
-        )
-        batch = q.data or []
-        all_rows.extend(batch)
-        if len(batch) < page_size:
-            break
-        offset += page_size
-    all_rows.extend(_righe_quote_gruppo(sb, ristorante_id, data_da, data_a))
-    if not all_rows:
-        return {}
-    df = pd.DataFrame(all_rows)
-    df["totale_riga"] = pd.to_numeric(df.get("totale_riga"), errors="coerce").fillna(0)
-    df = df[df["categoria"].isin(_CATEGORIE_FB_M) & (df["totale_riga"] > 0)]
-    return df.groupby("categoria")["totale_riga"].sum().to_dict()
+    """Ritorna dict {categoria: totale} del periodo (vedi _load_fatture_fb_per_categoria_e_mese)."""
+    out: Dict[str, float] = {}
+    for (_a, _m, cat), v in _load_fatture_fb_per_categoria_e_mese(sb, ristorante_id, data_da, data_a).items():
+        out[cat] = out.get(cat, 0.0) + v
+    return out
+
+
+def _spezza_periodo_in_mesi(data_da: str, data_a: str) -> tuple:
+    """Mesi interi di [data_da, data_a] e i tratti di mese ai bordi [(da, a), ...]."""
+    from calendar import monthrange
+    d0, d1 = date.fromisoformat(str(data_da)[:10]), date.fromisoformat(str(data_a)[:10])
+    interi: List[tuple] = []
+    bordi: List[tuple] = []
+    y, m = d0.year, d0.month
+    while (y, m) <= (d1.year, d1.month):
+        inizio, fine = date(y, m, 1), date(y, m, monthrange(y, m)[1])
+        da, a = max(inizio, d0), min(fine, d1)
+        if (da, a) == (inizio, fine):
+            interi.append((y, m))
+        else:
+            bordi.append((da.isoformat(), a.isoformat()))
+        m += 1
+        if m > 12:
+            y += 1
+            m = 1
+    return interi, bordi
 
 
 def _load_fatture_fb_per_categoria_e_mese(
     sb, ristorante_id: str, data_da: str, data_a: str,
 ) -> "Dict[tuple, float]":
-    """Ritorna dict {(anno, mese, categoria): totale}."""
+    """Ritorna dict {(anno, mese, categoria): totale}.
+
+    I mesi interi del periodo vengono dal cubo costi_mensili_cubo (base data
+    documento, righe della sede piu' quote di gruppo, storni esclusi): una
+    lettura per tutto il periodo. I tratti di mese ai bordi, e tutto il periodo
+    se il cubo non risponde, dalle righe fattura.
+    """
+    rid = str(ristorante_id)
+    return _load_fatture_fb_per_categoria_e_mese_sedi(sb, [rid], data_da, data_a)[rid]
+
+
+def _load_fatture_fb_per_categoria_e_mese_sedi(
+    sb, ristorante_ids: List[str], data_da: str, data_a: str,
+) -> "Dict[str, Dict[tuple, float]]":
+    """Come _load_fatture_fb_per_categoria_e_mese per piu' sedi: {rid: {(anno, mese, cat): €}}.
+
+    Il cubo si legge una volta per tutte le sedi (viste di catena). Quello che
+    resta per sede (bordi di mese, fallback sulle righe) va con un pool limitato.
+    """
+    from services import costi_cubo
+    ids = [str(r) for r in (ristorante_ids or [])]
+    out: Dict[str, Dict[tuple, float]] = {rid: {} for rid in ids}
+    if not ids:
+        return out
+    try:
+        interi, bordi = _spezza_periodo_in_mesi(data_da, data_a)
+        if interi:
+            celle = costi_cubo.leggi_mensile(
+                ids, interi[0][0], interi[-1][0],
+                base=costi_cubo.BASE_DOCUMENTO, supabase_client=sb,
+            )
+            mesi = set(interi)
+            for (rid, a, m, cat), v in costi_cubo.per_categoria(celle, _CATEGORIE_FB_M).items():
+                if (a, m) in mesi and rid in out:
+                    out[rid][(a, m, cat)] = v
+    except Exception as exc:
+        logger.warning("costi_mensili_cubo non leggibile per %s, ricado sulle righe: %s", ",".join(ids), exc)
+        righe = in_parallelo(
+            lambda rid: _fb_per_categoria_e_mese_da_righe(sb, rid, data_da, data_a),
+            ids, nome="fb-categoria",
+        )
+        return dict(zip(ids, righe))
+    if bordi:
+        def _bordi_sede(rid: str) -> Dict[tuple, float]:
+            acc: Dict[tuple, float] = {}
+            for da, a in bordi:
+                for k, v in _fb_per_categoria_e_mese_da_righe(sb, rid, da, a).items():
+                    acc[k] = acc.get(k, 0.0) + v
+            return acc
+
+        for rid, acc in zip(ids, in_parallelo(_bordi_sede, ids, nome="fb-categoria")):
+            for k, v in acc.items():
+                out[rid][k] = out[rid].get(k, 0.0) + v
+    return out
+
+
+def _fb_per_categoria_e_mese_da_righe(
+    sb, ristorante_id: str, data_da: str, data_a: str,
+) -> "Dict[tuple, float]":
+    """Come _load_fatture_fb_per_categoria_e_mese, dalle righe fattura del periodo."""
     import pandas as pd
     page_size = 1000
     all_rows: List[Dict[str, Any]] = []
@@ -7667,9 +8229,9 @@ def _load_fatture_fb_per_categoria_e_mese(
             .eq("ristorante_id", ristorante_id)
             .is_("deleted_at", "null")
             .neq("categoria", "Da Classificare")
-            # Vedi _load_fatture_fb_for_period: escludere le righe ripartite
-            # sulla sede tecnica per evitare doppio conteggio col meccanismo
-            # quote_riparto_* gia' proiettato sui singoli PV.
+            # Le fatture ripartite sul gruppo arrivano gia' come quote_riparto_*
+            # sui singoli PV: contarle anche qui sulla sede tecnica sarebbe doppio
+            # conteggio. Stesso filtro di _calcola_costi_auto_per_periodo.
             .neq("ripartita_su_gruppo", True)
             .gte("data_documento", data_da)
             .lte("data_documento", data_a)
@@ -7718,69 +8280,36 @@ def _load_num_documento_map(sb, ristorante_id: str) -> dict:
 
 def _calcola_costi_auto_per_mese(sb, ristorante_id: str, anno: int, mese: int) -> tuple:
     """Aggrega costi F&B e Spese Generali dalle fatture per il mese specifico."""
-    from datetime import date as _date
-    from calendar import monthrange
-    last_day = monthrange(anno, mese)[1]
-    data_da = f"{anno}-{mese:02d}-01"
-    data_a = f"{anno}-{mese:02d}-{last_day:02d}"
-
-    spese_gen_categorie = set(_CATEGORIE_SPESE_GENERALI)
-
-    fb_tot = 0.0
-    spese_tot = 0.0
-    page = 0
-    page_size = 1000
-    while True:
-        resp = (
-            sb.table("fatture")
-            .select("categoria,totale_riga,data_documento,data_competenza")
-            .eq("ristorante_id", ristorante_id)
-            .is_("deleted_at", "null")
-            .neq("categoria", "Da Classificare")
-            # Le fatture ripartite sul gruppo arrivano gia' come quote_riparto_*
-            # sui singoli PV: contarle anche qui le sottrarrebbe due volte dal MOL.
-            # Stesso filtro della RPC costi_automatici_mensili e di
-            # margine_service.calcola_costi_automatici_per_anno.
-            .neq("ripartita_su_gruppo", True)
-            .or_(
-                f"and(data_competenza.gte.{data_da},data_competenza.lte.{data_a}),"
-                f"and(data_competenza.is.null,data_documento.gte.{data_da},data_documento.lte.{data_a})"
-            )
-            .range(page * page_size, (page + 1) * page_size - 1)
-            .execute()
-        )
-        rows = resp.data or []
-        if not rows:
-            break
-        for r in rows:
-            cat = str(r.get("categoria") or "")
-            try:
-                tot = float(r.get("totale_riga") or 0)
-            except (TypeError, ValueError):
-                tot = 0.0
-            if cat in spese_gen_categorie:
-                spese_tot += tot
-            elif cat and cat not in CATEGORIE_NOTE_WORKER:
-                fb_tot += tot
-        if len(rows) < page_size:
-            break
-        page += 1
-
-    return round(fb_tot, 2), round(spese_tot, 2)
+    return _calcola_costi_auto_per_periodo(sb, ristorante_id, [(anno, mese)])[(anno, mese)]
 
 
 def _calcola_costi_auto_per_periodo(sb, ristorante_id: str, mesi_target: list) -> dict:
     """Aggrega costi auto F&B/Spese per TUTTI i mesi del periodo in UNA passata.
 
-    Prima get_margini_analisi chiamava _calcola_costi_auto_per_mese mese-per-mese:
-    12 scansioni della tabella fatture per un anno. Qui carichiamo le righe
-    dell'intero range una volta sola e raggruppiamo per (anno, mese) in Python.
+    Legge il cubo costi_mensili_cubo (base competenza): una lettura indicizzata
+    per tutto il periodo, qualunque sia il numero di righe del cliente. Se il
+    cubo non risponde, carica le righe dell'intero range una volta sola e
+    raggruppa per (anno, mese) in Python, con le stesse regole.
     Ritorna {(anno, mese): (fb_tot, spese_tot)}.
     """
     from calendar import monthrange
+    from services import costi_cubo
     if not mesi_target:
         return {}
 
+    try:
+        anni = [y for y, _ in mesi_target]
+        celle = costi_cubo.leggi_mensile([ristorante_id], min(anni), max(anni), supabase_client=sb)
+        costi = costi_cubo.costi_automatici(
+            celle, spese=_CATEGORIE_SPESE_GENERALI, escluse=CATEGORIE_NOTE_WORKER,
+        )
+        return {
+            (y, m): tuple(round(v, 2) for v in costi.get((str(ristorante_id), y, m), (0.0, 0.0)))
+            for (y, m) in mesi_target
+        }
+    except Exception as exc:
+        logger.warning("costi_mensili_cubo non leggibile per %s, ricado sulle righe: %s", ristorante_id, exc)
+
     y0, m0 = min(mesi_target)
     y1, m1 = max(mesi_target)
     data_da = f"{y0}-{m0:02d}-01"
@@ -7799,8 +8328,10 @@ def _calcola_costi_auto_per_periodo(sb, ristorante_id: str, mesi_target: list) -
             .eq("ristorante_id", ristorante_id)
             .is_("deleted_at", "null")
             .neq("categoria", "Da Classificare")
-            # Vedi _calcola_costi_auto_per_mese: le fatture ripartite entrano gia'
-            # come quote_riparto_* sui PV, contarle qui e' doppio conteggio.
+            # Le fatture ripartite sul gruppo arrivano gia' come quote_riparto_*
+            # sui singoli PV: contarle anche qui le sottrarrebbe due volte dal MOL.
+            # Stesso filtro della RPC costi_automatici_mensili e di
+            # margine_service.calcola_costi_automatici_per_anno.
             .neq("ripartita_su_gruppo", True)
             .or_(
                 f"and(data_competenza.gte.{data_da},data_competenza.lte.{data_a}),"
@@ -7859,6 +8390,7 @@ def _aggrega_mensili_margini(sb, ristorante_id: str, d_da, d_a) -> dict:
     )
     margini_map = {(int(r["anno"]), int(r["mese"])): r for r in (margini_resp.data or [])}
     mensile_overrides = _load_mensile_overrides(sb, ristorante_id, annos)
+    costi_auto = _calcola_costi_auto_per_periodo(sb, ristorante_id, mesi_target)
 
     tot = {"lordo": 0.0, "netto": 0.0, "fb": 0.0, "pm": 0.0,
            "spese": 0.0, "pers": 0.0, "mol": 0.0, "mesi_attivi": 0,
@@ -7866,7 +8398,7 @@ def _aggrega_mensili_margini(sb, ristorante_id: str, d_da, d_a) -> dict:
            "spark_spese": [], "spark_personale": [], "spark_mol": []}
     for (yy, mm) in mesi_target:
         r = margini_map.get((yy, mm), {})
-        fb_auto, spese_auto = _calcola_costi_auto_per_mese(sb, ristorante_id, yy, mm)
+        fb_auto, spese_auto = costi_auto[(yy, mm)]
         ov = mensile_overrides.get((yy, mm))
         iva10 = ov["iva10"] if ov else float(r.get("fatturato_iva10") or 0)
         iva22 = ov["iva22"] if ov else float(r.get("fatturato_iva22") or 0)
@@ -7919,12 +8451,13 @@ def _aggrega_totali_margini(sb, ristorante_id: str, d_da, d_a) -> dict:
     )
     margini_map = {(int(r["anno"]), int(r["mese"])): r for r in (margini_resp.data or [])}
     mensile_overrides = _load_mensile_overrides(sb, ristorante_id, annos)
+    costi_auto = _calcola_costi_auto_per_periodo(sb, ristorante_id, mesi_target)
 
     tot = {"lordo": 0.0, "netto": 0.0, "fb": 0.0, "pm": 0.0,
            "spese": 0.0, "pers": 0.0, "mol": 0.0, "mesi_attivi": 0}
     for (yy, mm) in mesi_target:
         r = margini_map.get((yy, mm), {})
-        fb_auto, spese_auto = _calcola_costi_auto_per_mese(sb, ristorante_id, yy, mm)
+        fb_auto, spese_auto = costi_auto[(yy, mm)]
         ov = mensile_overrides.get((yy, mm))
         iva10 = ov["iva10"] if ov else float(r.get("fatturato_iva10") or 0)
         iva22 = ov["iva22"] if ov else float(r.get("fatturato_iva22") or 0)
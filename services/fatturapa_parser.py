@@ -0,0 +1,367 @@
+"""Parser FatturaPA in un solo passaggio, in streaming e blindato.
+
+Problema: per ogni fattura la vecchia catena faceva tre lavori sullo stesso
+documento:
+  1. decodifica in str provando fino a 7 encoding (decodifica_xml_sicuro);
+  2. parse COMPLETO con defusedxml solo per validare XXE, albero buttato via;
+  3. secondo parse con xmltodict in un albero di dict annidati, poi visitato
+     con safe_get.
+Su una fattura GDO da qualche migliaio di righe l'albero xmltodict pesa decine
+di MB (un dict + un OrderedDict per elemento) e il documento veniva analizzato
+due volte per intero.
+
+Qui un parser expat guidato a eventi (stdlib, gia' la base di defusedxml) legge
+i byte una volta e scrive direttamente:
+  - `FatturaPA.testata`: le parti fuori dai body (FatturaElettronicaHeader e
+    simili) come piccolo dict nella STESSA forma di xmltodict, cosi' gli
+    estrattori esistenti (estrai_fornitore_xml, estrai_piva_cessionario_xml,
+    estrai_indirizzo_destinatario) restano invariati;
+  - `FatturaPA.corpi`: un `CorpoFattura` tipizzato per FatturaElettronicaBody,
+    con i campi di DatiGenerali/DatiRiepilogo/DatiPagamento/DatiDDT e le righe
+    DettaglioLinee come `LineaFattura`.
+Nessun albero per le righe. Con `solo_primo_corpo=True` (lotti multi-body:
+estrai_dati_da_xml ha sempre usato solo il primo) i body successivi vengono
+scorsi senza allocare nulla.
+
+Sicurezza (come defusedxml): dichiarazioni di entita', entita' esterne e
+parameter entity sono rifiutate con XMLNonSicuro; le DOCTYPE senza entita' sono
+tollerate. Expat >= 2.4 limita anche l'amplificazione (billion laughs).
+
+Encoding: i byte vanno direttamente a expat, che onora il prolog (UTF-8/16,
+latin-1 e le codifiche a un byte note a Python). Se expat non riesce a leggere
+il documento (encoding multibyte non supportato, prolog che mente, byte cp1252
+in un file dichiarato UTF-8) si ripiega sulla cascata storica di
+`decodifica_bytes_xml` e si rifà il parse sulla stringa: costa un secondo
+passaggio, ma solo sui documenti che prima ne facevano tre.
+
+Benchmark vecchio/nuovo percorso sullo stesso corpus: scripts/bench_fatturapa_parser.py.
+"""
+
+from __future__ import annotations
+
+import re
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional, Tuple, Union
+from xml.parsers import expat
+
+from config.logger_setup import get_logger
+
+logger = get_logger('fatturapa_parser')
+
+
+class XMLNonSicuro(ValueError):
+    """Il documento dichiara entita' (XXE / entity expansion): rifiutato."""
+
+
+@dataclass(slots=True)
+class LineaFattura:
+    """Una riga DettaglioLinee. Testi come nell'XML (strip, vuoto → None)."""
+
+    numero_linea: Optional[str] = None
+    descrizione: Optional[str] = None
+    quantita: Optional[str] = None
+    unita_misura: Optional[str] = None
+    prezzo_unitario: Optional[str] = None
+    prezzo_totale: Optional[str] = None
+    aliquota_iva: Optional[str] = None
+    # CodiceValore del PRIMO CodiceArticolo ('' se la riga non ne ha).
+    codice_articolo: Optional[str] = ''
+    # ScontoMaggiorazione: (Tipo, Percentuale). Tipo assente → 'SC' (default SDI).
+    sconti: List[List[Optional[str]]] = field(default_factory=list)
+
+
+@dataclass(slots=True)
+class CorpoFattura:
+    """Un FatturaElettronicaBody: i campi usati dall'estrazione, gia' tipizzati."""
+
+    tipo_documento: Optional[str] = None
+    data: Optional[str] = None
+    numero: Optional[str] = None
+    importo_totale: Optional[str] = None
+    # DatiRiepilogo: (ImponibileImporto, Imposta)
+    riepiloghi: List[List[Optional[str]]] = field(default_factory=list)
+    # DettaglioPagamento: (DataScadenzaPagamento, GiorniTerminiPagamento).
+    # `pagamenti` = Body/DatiPagamento (canonico), `pagamenti_dati_generali` =
+    # Body/DatiGenerali/DatiPagamento (flussi storici).
+    pagamenti: List[List[Optional[str]]] = field(default_factory=list)
+    pagamenti_dati_generali: List[List[Optional[str]]] = field(default_factory=list)
+    # DatiDDT: (DataDDT, [RiferimentoNumeroLinea, ...])
+    ddt: List[List[Any]] = field(default_factory=list)
+    # DatiBeniServizi/DettaglioLinee, e DettaglioLinee appese direttamente al body.
+    linee: List[LineaFattura] = field(default_factory=list)
+    linee_fuori_beni_servizi: List[LineaFattura] = field(default_factory=list)
+
+    def righe(self) -> List[LineaFattura]:
+        return self.linee or self.linee_fuori_beni_servizi
+
+
+@dataclass(slots=True)
+class FatturaPA:
+    testata: Dict[str, Any] = field(default_factory=dict)
+    corpi: List[CorpoFattura] = field(default_factory=list)
+    n_corpi: int = 0
+
+
+# ── Decodifica (ripiego) ─────────────────────────────────────────────────────
+
+def decodifica_bytes_xml(contenuto_bytes: bytes) -> str:
+    """Bytes → str con la cascata di encoding storica (prolog, UTF-8, cp1252, CJK,
+    latin-1, charset-normalizer, UTF-8 con sostituzione). Non valida l'XML."""
+    # ── Step 1: Leggi encoding dichiarato nel prolog XML ─────────────
+    # Es: <?xml version='1.0' encoding='GB2312'?>
+    xml_prolog = contenuto_bytes[:300].decode('ascii', errors='ignore')
+    _enc_match = re.search(r'encoding=["\']([^"\']+)["\']', xml_prolog, re.IGNORECASE)
+    declared_enc = _enc_match.group(1).strip().lower() if _enc_match else None
+    if declared_enc:
+        logger.info(f"📄 Encoding dichiarato nel prolog XML: {declared_enc}")
+
+    # ── Step 2: Costruisci lista priorità encoding ────────────────────
+    # Prima il dichiarato (se non è UTF-8, già incluso sotto), poi UTF-8,
+    # poi Windows-1252 (comune fatture italiane su Windows), poi CJK, poi latin-1
+    encodings_to_try = []
+    if declared_enc and declared_enc not in ('utf-8', 'utf8', 'utf_8'):
+        encodings_to_try.append(declared_enc)
+    encodings_to_try.extend(['utf-8-sig', 'utf-8', 'cp1252', 'gb2312', 'gbk', 'big5', 'latin-1'])
+
+    for encoding in encodings_to_try:
+        try:
+            contenuto = contenuto_bytes.decode(encoding)
+            logger.info(f"✅ File XML decodificato con encoding: {encoding}")
+            return contenuto
+        except (UnicodeDecodeError, LookupError):
+            continue
+
+    # ── Step 3: Usa charset-normalizer per rilevamento automatico ─
+    try:
+        from charset_normalizer import from_bytes as _from_bytes
+        _result = _from_bytes(contenuto_bytes).best()
+        if _result:
+            logger.info(f"✅ Encoding rilevato da charset-normalizer: {_result.encoding}")
+            return str(_result)
+        raise ValueError("charset-normalizer non ha riconosciuto l'encoding")
+    except (ImportError, ValueError) as enc_err:
+        # Fallback finale: sostituisci caratteri non decodificabili
+        logger.warning(f"⚠️ Encoding fallback UTF-8 con sostituzione: {enc_err}")
+        return contenuto_bytes.decode('utf-8', errors='replace')
+
+
+# ── Parser a eventi ──────────────────────────────────────────────────────────
+
+_BODY = 'FatturaElettronicaBody'
+_DGD = ('DatiGenerali', 'DatiGeneraliDocumento')
+_CAMPI_DOCUMENTO = {
+    _DGD + ('TipoDocumento',): 'tipo_documento',
+    _DGD + ('Data',): 'data',
+    _DGD + ('Numero',): 'numero',
+    _DGD + ('ImportoTotaleDocumento',): 'importo_totale',
+}
+_CAMPI_LINEA = {
+    'NumeroLinea': 'numero_linea',
+    'Descrizione': 'descrizione',
+    'Quantita': 'quantita',
+    'UnitaMisura': 'unita_misura',
+    'PrezzoUnitario': 'prezzo_unitario',
+    'PrezzoTotale': 'prezzo_totale',
+    'AliquotaIVA': 'aliquota_iva',
+}
+_LINEE = {('DatiBeniServizi', 'DettaglioLinee'): 'linee', ('DettaglioLinee',): 'linee_fuori_beni_servizi'}
+_PAGAMENTI = {('DatiPagamento',): 'pagamenti', ('DatiGenerali', 'DatiPagamento'): 'pagamenti_dati_generali'}
+
+
+def _nome_locale(tag: str) -> str:
+    return tag.rpartition(':')[2]
+
+
+class _Costruttore:
+    """Stato del parse: pila dei nomi, testo corrente, record aperti."""
+
+    def __init__(self, solo_primo_corpo: bool) -> None:
+        self.fattura = FatturaPA()
+        self.solo_primo_corpo = solo_primo_corpo
+        self.pila: List[str] = []
+        self.testo: List[str] = []
+        # Testata: pila di (dict figli | None) per costruire la forma xmltodict.
+        self.nodi: List[Optional[Dict[str, Any]]] = []
+        self.corpo: Optional[CorpoFattura] = None
+        self.linea: Optional[LineaFattura] = None
+        self.in_codice = False
+        self.primo_codice = True
+
+    # Percorso relativo al body corrente (None se fuori da un body tracciato).
+    def _rel(self) -> Optional[Tuple[str, ...]]:
+        if self.corpo is None or len(self.pila) < 2:
+            return None
+        return tuple(self.pila[2:])
+
+    def inizio(self, tag: str, _attrs) -> None:
+        nome = _nome_locale(tag)
+        self.pila.append(nome)
+        self.testo = []
+        depth = len(self.pila)
+        if depth == 1:
+            return
+        if self.pila[1] == _BODY:
+            if depth == 2:
+                self.fattura.n_corpi += 1
+                if not (self.solo_primo_corpo and self.fattura.corpi):
+                    self.corpo = CorpoFattura()
+                    self.fattura.corpi.append(self.corpo)
+                return
+            rel = self._rel()
+            if rel is None:
+                return
+            corpo = self.corpo
+            attr_linee = _LINEE.get(rel)
+            if attr_linee:
+                self.linea = LineaFattura()
+                getattr(corpo, attr_linee).append(self.linea)
+                self.primo_codice = True
+            elif self.linea is not None and len(rel) >= 2 and rel[-2] == 'DettaglioLinee':
+                if nome == 'ScontoMaggiorazione':
+                    self.linea.sconti.append(['SC', None])
+                elif nome == 'CodiceArticolo':
+                    self.in_codice = True
+            elif rel == ('DatiBeniServizi', 'DatiRiepilogo'):
+                corpo.riepiloghi.append([None, None])
+            elif rel == ('DatiGenerali', 'DatiDDT'):
+                corpo.ddt.append([None, []])
+            elif nome == 'DettaglioPagamento' and rel[:-1] in _PAGAMENTI:
+                getattr(corpo, _PAGAMENTI[rel[:-1]]).append([None, None])
+            return
+        # Testata: nodo dict aperto, valorizzato alla chiusura.
+        self.nodi.append(None)
+
+    def testo_car(self, dati: str) -> None:
+        self.testo.append(dati)
+
+    def fine(self, _tag: str) -> None:
+        testo = ''.join(self.testo).strip() or None
+        self.testo = []
+        nome = self.pila[-1]
+        depth = len(self.pila)
+        try:
+            if depth == 1:
+                return
+            if self.pila[1] == _BODY:
+                self._fine_body(nome, depth, testo)
+                return
+            valore = self.nodi.pop()
+            if valore is None:
+                valore = testo
+            genitore = self.nodi[-1] if self.nodi else self.fattura.testata
+            if genitore is None:
+                genitore = {}
+                if self.nodi:
+                    self.nodi[-1] = genitore
+            if nome in genitore:
+                esistente = genitore[nome]
+                if isinstance(esistente, list):
+                    esistente.append(valore)
+                else:
+                    genitore[nome] = [esistente, valore]
+            else:
+                genitore[nome] = valore
+        finally:
+            self.pila.pop()
+
+    def _fine_body(self, nome: str, depth: int, testo: Optional[str]) -> None:
+        if depth == 2:
+            self.corpo = None
+            return
+        rel = self._rel()
+        if rel is None:
+            return
+        corpo = self.corpo
+        if rel in _LINEE:
+            self.linea = None
+            return
+        linea = self.linea
+        if linea is not None and len(rel) >= 2:
+            padre = rel[-2]
+            if padre == 'DettaglioLinee' and rel[:-1] in _LINEE:
+                if nome == 'CodiceArticolo':
+                    self.in_codice = False
+                    self.primo_codice = False
+                attr = _CAMPI_LINEA.get(nome)
+                if attr and getattr(linea, attr) is None:
+                    setattr(linea, attr, testo)
+                return
+            if padre == 'ScontoMaggiorazione' and rel[:-2] in _LINEE and linea.sconti:
+                if nome == 'Tipo':
+                    linea.sconti[-1][0] = testo
+                elif nome == 'Percentuale':
+                    linea.sconti[-1][1] = testo
+                return
+            if padre == 'CodiceArticolo' and nome == 'CodiceValore' and self.in_codice and self.primo_codice:
+                linea.codice_articolo = testo
+                return
+        attr = _CAMPI_DOCUMENTO.get(rel)
+        if attr:
+            if getattr(corpo, attr) is None:
+                setattr(corpo, attr, testo)
+        elif rel[:-1] == ('DatiBeniServizi', 'DatiRiepilogo') and corpo.riepiloghi:
+            if nome == 'ImponibileImporto':
+                corpo.riepiloghi[-1][0] = testo
+            elif nome == 'Imposta':
+                corpo.riepiloghi[-1][1] = testo
+        elif rel[:-1] == ('DatiGenerali', 'DatiDDT') and corpo.ddt:
+            if nome == 'DataDDT' and corpo.ddt[-1][0] is None:
+                corpo.ddt[-1][0] = testo
+            elif nome == 'RiferimentoNumeroLinea' and testo is not None:
+                corpo.ddt[-1][1].append(testo)
+        elif len(rel) >= 3 and rel[-2] == 'DettaglioPagamento' and rel[:-2] in _PAGAMENTI:
+            lista = getattr(corpo, _PAGAMENTI[rel[:-2]])
+            if lista:
+                if nome == 'DataScadenzaPagamento':
+                    lista[-1][0] = testo
+                elif nome == 'GiorniTerminiPagamento':
+                    lista[-1][1] = testo
+
+
+def _vieta_entita(*_args) -> None:
+    raise XMLNonSicuro("dichiarazione di entita' non consentita")
+
+
+def _vieta_esterna(*_args) -> int:
+    raise XMLNonSicuro("entita' esterna non consentita")
+
+
+def _esegui(sorgente: Union[bytes, str], solo_primo_corpo: bool) -> FatturaPA:
+    costruttore = _Costruttore(solo_primo_corpo)
+    parser = expat.ParserCreate()
+    parser.SetParamEntityParsing(expat.XML_PARAM_ENTITY_PARSING_NEVER)
+    parser.EntityDeclHandler = _vieta_entita
+    parser.UnparsedEntityDeclHandler = _vieta_entita
+    parser.ExternalEntityRefHandler = _vieta_esterna
+    parser.buffer_text = True
+    parser.StartElementHandler = costruttore.inizio
+    parser.EndElementHandler = costruttore.fine
+    parser.CharacterDataHandler = costruttore.testo_car
+    parser.Parse(sorgente, True)
+    return costruttore.fattura
+
+
+def parse_fattura(sorgente: Union[bytes, str], solo_primo_corpo: bool = False) -> FatturaPA:
+    """Analizza una FatturaPA (bytes o str) in un solo passaggio.
+
+    Solleva ValueError (XMLNonSicuro per XXE/entita') se il documento non e'
+    XML valido o non e' sicuro: stesso contratto di decodifica_xml_sicuro.
+    """
+    try:
+        return _esegui(sorgente, solo_primo_corpo)
+    except XMLNonSicuro as exc:
+        logger.warning(f"⚠️ Validazione XML sicurezza fallita: {exc}")
+        raise
+    except (expat.ExpatError, ValueError, LookupError) as exc:
+        # ValueError: pyexpat rifiuta gli encoding multibyte (GB2312, Big5...).
+        if not isinstance(sorgente, bytes):
+            raise ValueError(f"XML non valido o potenzialmente pericoloso: {exc}") from exc
+        logger.info(f"📄 Parse diretto dei byte fallito ({exc}): ripiego sulla decodifica")
+    try:
+        return _esegui(decodifica_bytes_xml(sorgente), solo_primo_corpo)
+    except XMLNonSicuro as exc:
+        logger.warning(f"⚠️ Validazione XML sicurezza fallita: {exc}")
+        raise
+    except expat.ExpatError as exc:
+        logger.warning(f"⚠️ Validazione XML sicurezza fallita: {exc}")
+        raise ValueError(f"XML non valido o potenzialmente pericoloso: {exc}") from exc
@@ -0,0 +1,307 @@
+"""Invio concorrente dei batch GPT entro i limiti RPM/TPM di OpenAI.
+
+Problema: la categorizzazione post-upload spezzava le descrizioni in chunk da
+30 e chiamava l'AI un chunk dopo l'altro. Un primo upload da 600 righe
+aspettava ~20 round-trip in serie (2-4 s l'uno), mentre il limite OpenAI
+dell'account ne regge molti di piu' in parallelo. Il 429 che arrivava quando
+piu' upload si sovrapponevano era gestito solo dal retry tenacity della
+singola chiamata, senza che le altre chiamate in volo lo sapessero.
+
+Tre pezzi:
+
+- TokenBucket: due secchi (richieste e token al minuto) dimensionati con
+  OPENAI_RPM_LIMIT / OPENAI_TPM_LIMIT. Ogni chiamata a OpenAI passa da
+  `attendi_slot(token_stimati)` prima di partire. Il costo e' stimato come
+  prompt + max_tokens: e' lo stesso conto con cui OpenAI riserva la quota.
+- Backoff 429 condiviso: `segnala_429` fissa una scadenza (Retry-After se c'e',
+  altrimenti esponenziale fino a 60 s) in memoria E in un file nella tempdir,
+  cosi' la rispettano anche gli altri processi sulla stessa macchina (uvicorn
+  worker, queue worker).
+- `esegui_in_parallelo`: esegue i lavori in un pool e li restituisce man mano
+  che finiscono (generatore), cosi' il chiamante salva i risultati parziali
+  senza aspettare il batch piu' lento. Il contesto (ContextVar di
+  ristorante/utente per il tracking costi) e' copiato in ogni thread.
+
+`dimensiona_batch` sceglie la dimensione dei batch dalla stima token delle
+descrizioni invece che da un numero fisso: descrizioni lunghe → batch piu'
+piccoli, entro il tetto ONEFLUX_AI_BATCH_MAX.
+
+scripts/bench_gpt_dispatcher.py lo prova contro un finto server OpenAI locale.
+"""
+
+from __future__ import annotations
+
+import contextvars
+import os
+import tempfile
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Callable, Iterator, List, Optional, Sequence, Tuple, TypeVar
+
+from config.logger_setup import get_logger
+
+logger = get_logger('gpt_dispatcher')
+
+T = TypeVar('T')
+R = TypeVar('R')
+
+# ~3 caratteri per token sulle descrizioni di fattura (maiuscolo, abbreviazioni,
+# numeri): stima prudente, i tokenizer GPT ne fanno ~3.5-4 sull'italiano corrente.
+_CARATTERI_PER_TOKEN = 3
+# Ogni articolo nel payload porta anche idx/fornitore/iva in JSON.
+_TOKEN_EXTRA_PER_ARTICOLO = 20
+# Risposta per articolo: {"idx": n, "categoria": "...", "confidence": "..."}.
+TOKEN_RISPOSTA_PER_ARTICOLO = 30
+_BACKOFF_MAX_S = 60.0
+
+
+def _env_int(nome: str, default: int) -> int:
+    try:
+        return int(os.getenv(nome, default))
+    except (TypeError, ValueError):
+        return default
+
+
+def concorrenza_default() -> int:
+    return max(1, _env_int("ONEFLUX_AI_CONCORRENZA", 4))
+
+
+def batch_max_default() -> int:
+    return max(1, _env_int("ONEFLUX_AI_BATCH_MAX", 50))
+
+
+def stima_token(testo: str) -> int:
+    return len(testo or '') // _CARATTERI_PER_TOKEN + 1
+
+
+# ============================================================
+# TOKEN BUCKET
+# ============================================================
+
+class TokenBucket:
+    """Secchi richieste/token al minuto con ricarica continua."""
+
+    def __init__(self, rpm: int, tpm: int, orologio: Callable[[], float] = time.monotonic,
+                 dormi: Callable[[float], None] = time.sleep):
+        self.rpm = max(1, int(rpm))
+        self.tpm = max(1, int(tpm))
+        self._orologio = orologio
+        self._dormi = dormi
+        self._richieste = float(self.rpm)
+        self._token = float(self.tpm)
+        self._ultimo = orologio()
+        self._lock = threading.Lock()
+
+    def _ricarica(self, adesso: float) -> None:
+        trascorso = max(0.0, adesso - self._ultimo)
+        self._ultimo = adesso
+        self._richieste = min(self.rpm, self._richieste + trascorso * self.rpm / 60.0)
+        self._token = min(self.tpm, self._token + trascorso * self.tpm / 60.0)
+
+    def acquisisci(self, token: int) -> float:
+        """Blocca finche' c'e' posto per una richiesta da `token`; ritorna i secondi attesi."""
+        token = min(max(0, int(token)), self.tpm)  # una richiesta oltre il TPM passa da sola
+        atteso = 0.0
+        while True:
+            with self._lock:
+                self._ricarica(self._orologio())
+                if self._richieste >= 1 and self._token >= token:
+                    self._richieste -= 1
+                    self._token -= token
+                    return atteso
+                attesa = max(
+                    (1 - self._richieste) * 60.0 / self.rpm,
+                    (token - self._token) * 60.0 / self.tpm,
+                )
+            attesa = min(max(attesa, 0.01), 1.0)
+            self._dormi(attesa)
+            atteso += attesa
+
+
+_bucket: Optional[TokenBucket] = None
+_bucket_lock = threading.Lock()
+
+
+def bucket() -> TokenBucket:
+    global _bucket
+    with _bucket_lock:
+        if _bucket is None:
+            _bucket = TokenBucket(
+                rpm=_env_int("OPENAI_RPM_LIMIT", 500),
+                tpm=_env_int("OPENAI_TPM_LIMIT", 1_000_000),
+            )
+        return _bucket
+
+
+# ============================================================
+# BACKOFF 429 CONDIVISO (thread + processi)
+# ============================================================
+
+_FILE_BACKOFF = os.path.join(tempfile.gettempdir(), "oneflux_openai_429.scadenza")
+_backoff_lock = threading.Lock()
+_pausa_fino_a = 0.0   # epoch (time.time): confrontabile fra processi
+_429_consecutivi = 0
+
+
+def e_rate_limit(exc: BaseException) -> bool:
+    """429 di OpenAI, riconosciuto senza importare openai (mockato nei test)."""
+    return getattr(exc, "status_code", None) == 429 or type(exc).__name__ == "RateLimitError"
+
+
+def _retry_after(exc: Optional[BaseException]) -> Optional[float]:
+    headers = getattr(getattr(exc, "response", None), "headers", None)
+    if not headers:
+        return None
+    try:
+        valore = headers.get("retry-after-ms")
+        if valore is not None:
+            return float(valore) / 1000.0
+        valore = headers.get("retry-after")
+        return float(valore) if valore is not None else None
+    except (TypeError, ValueError, AttributeError):
+        return None
+
+
+def _scadenza_da_file() -> float:
+    try:
+        with open(_FILE_BACKOFF, "r", encoding="ascii") as fh:
+            return float(fh.read().strip() or 0)
+    except (OSError, ValueError):
+        return 0.0
+
+
+def segnala_429(exc: Optional[BaseException] = None) -> float:
+    """Registra un 429: tutte le chiamate (anche di altri processi) aspettano. Ritorna i secondi."""
+    global _pausa_fino_a, _429_consecutivi
+    with _backoff_lock:
+        _429_consecutivi += 1
+        secondi = _retry_after(exc)
+        if secondi is None:
+            secondi = min(_BACKOFF_MAX_S, 2.0 ** _429_consecutivi)
+        secondi = min(_BACKOFF_MAX_S, max(0.0, secondi))
+        scadenza = time.time() + secondi
+        if scadenza > _pausa_fino_a:
+            _pausa_fino_a = scadenza
+            try:
+                tmp = f"{_FILE_BACKOFF}.{os.getpid()}"
+                with open(tmp, "w", encoding="ascii") as fh:
+                    fh.write(f"{scadenza:.3f}")
+                os.replace(tmp, _FILE_BACKOFF)
+            except OSError as err:
+                logger.debug("backoff 429 non condiviso su file: %s", err)
+    logger.warning("⏳ OpenAI 429: pausa condivisa di %.1fs", secondi)
+    return secondi
+
+
+def segnala_successo() -> None:
+    global _429_consecutivi
+    _429_consecutivi = 0
+
+
+def attendi_backoff(dormi: Callable[[float], None] = time.sleep) -> float:
+    """Dorme fino alla fine dell'eventuale pausa 429 in corso; ritorna i secondi attesi."""
+    scadenza = max(_pausa_fino_a, _scadenza_da_file())
+    attesa = min(_BACKOFF_MAX_S, scadenza - time.time())
+    if attesa <= 0:
+        return 0.0
+    dormi(attesa)
+    return attesa
+
+
+def attendi_slot(token_stimati: int) -> float:
+    """Da chiamare subito prima di ogni richiesta a OpenAI."""
+    return attendi_backoff() + bucket().acquisisci(token_stimati)
+
+
+def reset() -> None:
+    """Azzera bucket e backoff (test, cambio limiti a caldo)."""
+    global _bucket, _pausa_fino_a, _429_consecutivi
+    with _bucket_lock:
+        _bucket = None
+    with _backoff_lock:
+        _pausa_fino_a = 0.0
+        _429_consecutivi = 0
+    try:
+        os.remove(_FILE_BACKOFF)
+    except OSError:
+        pass
+
+
+# ============================================================
+# BATCH ADATTIVI E ESECUZIONE CONCORRENTE
+# ============================================================
+
+def dimensiona_batch(
+    descrizioni: Sequence[str],
+    max_articoli: Optional[int] = None,
+    max_token_risposta: int = 4096,
+    budget_token_input: int = 6000,
+) -> List[List[str]]:
+    """Spezza `descrizioni` (in ordine) in batch che stanno nei budget token.
+
+    Il tetto vero e' la risposta: oltre ~3/4 di max_tokens il JSON rischia il
+    troncamento (finish_reason=length) e gli articoli in coda tornano Da
+    Classificare.
+    """
+    max_articoli = max_articoli or batch_max_default()
+    max_per_risposta = max(1, int(max_token_risposta * 0.75) // TOKEN_RISPOSTA_PER_ARTICOLO)
+    limite = min(max_articoli, max_per_risposta)
+    batch: List[List[str]] = []
+    corrente: List[str] = []
+    token_correnti = 0
+    for desc in descrizioni:
+        t = stima_token(desc) + _TOKEN_EXTRA_PER_ARTICOLO
+        if corrente and (len(corrente) >= limite or token_correnti + t > budget_token_input):
+            batch.append(corrente)
+            corrente, token_correnti = [], 0
+        corrente.append(desc)
+        token_correnti += t
+    if corrente:
+        batch.append(corrente)
+    return batch
+
+
+def esegui_in_parallelo(
+    lavori: Sequence[T],
+    fn: Callable[[T], R],
+    concorrenza: Optional[int] = None,
+    primo_da_solo: bool = False,
+) -> Iterator[Tuple[T, Optional[R], Optional[BaseException]]]:
+    """Esegue `fn` su ogni lavoro e produce (lavoro, risultato, errore) in ordine di completamento.
+
+    Con un solo lavoro o concorrenza 1 resta tutto nel thread chiamante, in
+    ordine. Un'eccezione di `fn` non ferma gli altri lavori: arriva nel terzo
+    elemento della tupla.
+
+    primo_da_solo: il primo lavoro gira (e viene restituito) prima di aprire il
+    pool. Serve quando il primo esito puo' rendere inutili gli altri (quota AI
+    esaurita, worker giu'): si scopre con una richiesta invece che con N in volo.
+    """
+    concorrenza = concorrenza or concorrenza_default()
+    lavori = list(lavori)
+    if concorrenza <= 1 or len(lavori) <= 1:
+        for lavoro in lavori:
+            try:
+                yield lavoro, fn(lavoro), None
+            except Exception as exc:
+                yield lavoro, None, exc
+        return
+
+    if primo_da_solo:
+        yield from esegui_in_parallelo(lavori[:1], fn, concorrenza=1)
+        lavori = lavori[1:]
+
+    with ThreadPoolExecutor(max_workers=min(concorrenza, len(lavori)),
+                            thread_name_prefix="gpt-batch") as pool:
+        # Un Context per task: uno stesso Context non puo' essere attivo in due thread.
+        in_corso = {
+            pool.submit(contextvars.copy_context().run, fn, lavoro): lavoro
+            for lavoro in lavori
+        }
+        while in_corso:
+            fatti, _ = wait(in_corso, return_when=FIRST_COMPLETED)
+            for fut in fatti:
+                lavoro = in_corso.pop(fut)
+                exc = fut.exception()
+                yield lavoro, (None if exc else fut.result()), exc
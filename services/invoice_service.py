@@ -8,7 +8,7 @@ Questo modulo fornisce:
 - Categorizzazione automatica integrata
 
 Dipendenze:
-- xmltodict: Parsing XML
+- services.fatturapa_parser: Parsing XML FatturaPA (expat, un passaggio)
 - openai: Vision API per PDF/immagini
 - supabase: Database
 - streamlit: UI e secrets
@@ -17,10 +17,10 @@ Dipendenze:
 
 import json
 import re
+import time
 from datetime import datetime
 import pandas as pd
 import streamlit as st
-import xmltodict
 from defusedxml import ElementTree as _DefusedET
 from typing import List, Dict, Any, Optional
 
@@ -62,6 +62,7 @@ from utils.validation import (
 
 # Logger centralizzato
 from config.logger_setup import get_logger
+from services.fatturapa_parser import CorpoFattura, decodifica_bytes_xml, parse_fattura
 from config.constants import MAX_FILE_SIZE_P7M, VISION_DAILY_LIMIT, CATEGORIE_FOOD_BEVERAGE, FORNITORI_NEEDS_REVIEW_SEMPRE
 logger = get_logger('invoice')
 
@@ -123,7 +124,7 @@ def _normalizza_piva_cedente(value: Any) -> Optional[str]:
     return digits[:11]
 
 
-def _estrai_info_pagamento_xml(fattura: Dict[str, Any], tipo_documento: str) -> Dict[str, Any]:
+def _estrai_info_pagamento_xml(corpo: CorpoFattura, tipo_documento: str) -> Dict[str, Any]:
     """
     Estrae scadenza XML e giorni termini da DatiPagamento.
 
@@ -138,55 +139,24 @@ def _estrai_info_pagamento_xml(fattura: Dict[str, Any], tipo_documento: str) ->
 
     # Struttura canonica FatturaPA: FatturaElettronicaBody -> DatiPagamento.
     # Alcuni flussi storici potrebbero annidarlo in DatiGenerali: gestiamo entrambi.
-    dati_pagamento_raw = safe_get(
-        fattura,
-        ['FatturaElettronicaBody', 'DatiPagamento'],
-        default=None,
-        keep_list=True,
-    )
-    if not dati_pagamento_raw:
-        dati_pagamento_raw = safe_get(
-            fattura,
-            ['FatturaElettronicaBody', 'DatiGenerali', 'DatiPagamento'],
-            default=None,
-            keep_list=True,
-        )
-    if not dati_pagamento_raw:
+    dettagli = corpo.pagamenti or corpo.pagamenti_dati_generali
+    if not dettagli:
         return {'scadenza_xml': None, 'giorni_termini_xml': None}
 
-    if isinstance(dati_pagamento_raw, dict):
-        dati_pagamento_raw = [dati_pagamento_raw]
-
     scadenze: List[str] = []
     giorni: List[int] = []
-    for dati_pag in dati_pagamento_raw:
-        if not isinstance(dati_pag, dict):
-            continue
-        dettagli = dati_pag.get('DettaglioPagamento')
-        if dettagli is None:
-            continue
-        if isinstance(dettagli, dict):
-            dettagli = [dettagli]
-        if not isinstance(dettagli, list):
-            continue
-
-        for det in dettagli:
-            if not isinstance(det, dict):
-                continue
-
-            scadenza_raw = det.get('DataScadenzaPagamento')
-            if scadenza_raw:
-                try:
-                    scadenza_norm = pd.to_datetime(scadenza_raw, errors='coerce')
-                    if pd.notna(scadenza_norm):
-                        scadenze.append(scadenza_norm.strftime('%Y-%m-%d'))
-                except Exception:
-                    pass
+    for scadenza_raw, giorni_raw in dettagli:
+        if scadenza_raw:
+            try:
+                scadenza_norm = pd.to_datetime(scadenza_raw, errors='coerce')
+                if pd.notna(scadenza_norm):
+                    scadenze.append(scadenza_norm.strftime('%Y-%m-%d'))
+            except Exception:
+                pass
 
-            giorni_raw = det.get('GiorniTerminiPagamento')
-            giorni_val = _to_int_safe(giorni_raw)
-            if giorni_val is not None:
-                giorni.append(giorni_val)
+        giorni_val = _to_int_safe(giorni_raw)
+        if giorni_val is not None:
+            giorni.append(giorni_val)
 
     if scadenze:
         return {
@@ -319,15 +289,24 @@ def _estrai_xml_con_asn1crypto(contenuto_bytes: bytes) -> bytes | None:
     return None
 
 
+# Esito del probe `openssl version`, una volta per processo (None = non ancora provato).
+_OPENSSL_DISPONIBILE: Optional[bool] = None
+
+
 def _estrai_xml_con_openssl(contenuto_bytes: bytes) -> bytes | None:
     """Metodo 2: OpenSSL via subprocess (gestisce anche firme multiple/nidificate)."""
+    global _OPENSSL_DISPONIBILE
     import subprocess
     import tempfile
     import os
-    try:
-        # Verifica che openssl sia disponibile
-        subprocess.run(["openssl", "version"], capture_output=True, timeout=5)
-    except (FileNotFoundError, subprocess.TimeoutExpired):
+    if _OPENSSL_DISPONIBILE is None:
+        try:
+            # Verifica che openssl sia disponibile
+            subprocess.run(["openssl", "version"], capture_output=True, timeout=5)
+            _OPENSSL_DISPONIBILE = True
+        except (FileNotFoundError, subprocess.TimeoutExpired):
+            _OPENSSL_DISPONIBILE = False
+    if not _OPENSSL_DISPONIBILE:
         return None
 
     tmp_in = None
@@ -584,6 +563,62 @@ def _pulisci_xml_bytes(xml_bytes: bytes) -> bytes:
     return xml_bytes
 
 
+# Ripieghi senza perdita dopo il lettore DER, nell'ordine storico. Vengono
+# riordinati per i successi (del fornitore, poi globali): su una busta fuori
+# standard la strategia che ha funzionato l'ultima volta va provata per prima.
+_P7M_RIPIEGHI = (
+    ('asn1crypto', _estrai_xml_con_asn1crypto),
+    ('pattern', _estrai_xml_con_pattern),
+    ('der_scan', _estrai_xml_con_der_scan),
+)
+
+_RE_PIVA_CEDENTE = re.compile(
+    rb'<(?:\w+:)?CedentePrestatore\b.{0,600}?<(?:\w+:)?IdCodice>\s*([0-9A-Za-z]{8,16})\s*<',
+    re.DOTALL,
+)
+
+
+def _piva_cedente_grezza(contenuto: bytes) -> Optional[str]:
+    """P.IVA del cedente letta con una regex sui byte (XML o busta p7m in chiaro).
+
+    Sulla busta serve a scegliere l'ordine dei ripieghi PRIMA di estrarre: se un
+    chunk DER spezza il tag la regex non trova nulla e si usa l'ordine globale.
+    """
+    m = _RE_PIVA_CEDENTE.search(contenuto, 0, 64 * 1024)
+    return m.group(1).decode('ascii') if m else None
+
+
+def _estrai_xml_p7m_in_cascata(raw_bytes: bytes) -> tuple:
+    """(metodo, xml_bytes) della prima strategia che apre la busta, o (None, None).
+
+    Percorso caldo: il lettore DER/BER in-process (services.p7m_der), che copre
+    DER, BER a chunk e buste annidate. Seguono i ripieghi senza perdita in ordine
+    adattivo, poi OpenSSL (subprocess, ultimo fra quelli fedeli) e infine la
+    pulizia byte, che perde i caratteri non ASCII.
+    """
+    from services import worker_metrics
+    from services.p7m_der import estrai_contenuto_p7m
+
+    xml_bytes = estrai_contenuto_p7m(raw_bytes)
+    if xml_bytes is not None:
+        return 'der', xml_bytes
+
+    piva = _piva_cedente_grezza(raw_bytes)
+    del_fornitore = worker_metrics.p7m_conteggi(piva) if piva else {}
+    globali = worker_metrics.p7m_conteggi()
+    ripieghi = sorted(
+        _P7M_RIPIEGHI,
+        key=lambda voce: (-del_fornitore.get(voce[0], 0), -globali.get(voce[0], 0)),
+    )
+    for nome, funzione in ripieghi + [('openssl', _estrai_xml_con_openssl),
+                                      ('pulizia_byte', _estrai_xml_con_pulizia_byte)]:
+        xml_bytes = funzione(raw_bytes)
+        if xml_bytes is not None:
+            logger.info(f"📄 P7M aperto col ripiego '{nome}' (fornitore {piva or 'sconosciuto'})")
+            return nome, xml_bytes
+    return None, None
+
+
 def estrai_xml_da_p7m(file_caricato):
     """
     Estrae il contenuto XML da un file .p7m (firma digitale CAdES/PKCS#7).
@@ -613,36 +648,26 @@ def estrai_xml_da_p7m(file_caricato):
             logger.info("✅ P7M base64 decodificato in DER")
             raw_bytes = decoded
     
-    xml_bytes = None
-    
-    # Metodo 1: ASN.1/CMS parsing (più affidabile)
-    xml_bytes = _estrai_xml_con_asn1crypto(raw_bytes)
-    
-    # Metodo 2: OpenSSL (gestisce firme complesse/nidificate)
-    if xml_bytes is None:
-        xml_bytes = _estrai_xml_con_openssl(raw_bytes)
-    
-    # Metodo 3: ricerca pattern nel binario
-    if xml_bytes is None:
-        xml_bytes = _estrai_xml_con_pattern(raw_bytes)
-    
-    # Metodo 4: scansione manuale strutture DER per OCTET STRING con XML
-    if xml_bytes is None:
-        xml_bytes = _estrai_xml_con_der_scan(raw_bytes)
-    
-    # Metodo 5: rimuovi byte binari DER e riassembla XML dal testo pulito
-    # (essenziale per p7m con OCTET STRING chunked dove asn1crypto non è disponibile)
-    if xml_bytes is None:
-        xml_bytes = _estrai_xml_con_pulizia_byte(raw_bytes)
-    
-    # Se ancora nulla, riprova pattern sul contenuto originale (pre-base64 decode)
-    if xml_bytes is None and raw_bytes is not contenuto_bytes:
-        xml_bytes = _estrai_xml_con_pattern(contenuto_bytes)
-    
-    # Riprova pulizia byte sul contenuto originale
+    t0 = time.perf_counter()
+    metodo, xml_bytes = _estrai_xml_p7m_in_cascata(raw_bytes)
+
+    # Se ancora nulla, riprova pattern e pulizia byte sul contenuto originale
+    # (pre-base64 decode)
     if xml_bytes is None and raw_bytes is not contenuto_bytes:
-        xml_bytes = _estrai_xml_con_pulizia_byte(contenuto_bytes)
-    
+        for nome, funzione in (('pattern', _estrai_xml_con_pattern),
+                               ('pulizia_byte', _estrai_xml_con_pulizia_byte)):
+            xml_bytes = funzione(contenuto_bytes)
+            if xml_bytes is not None:
+                metodo = f"{nome}_originale"
+                break
+
+    from services import worker_metrics
+    worker_metrics.record_p7m(
+        metodo if xml_bytes else None,
+        _piva_cedente_grezza(xml_bytes) if xml_bytes else None,
+        (time.perf_counter() - t0) * 1000,
+    )
+
     if xml_bytes is None or len(xml_bytes) == 0:
         raise ValueError("Impossibile estrarre XML dal file .p7m - firma digitale non riconosciuta")
     
@@ -674,45 +699,9 @@ def decodifica_xml_sicuro(contenuto_bytes) -> str:
     Solleva ValueError se il contenuto non supera la validazione XXE.
     """
     if isinstance(contenuto_bytes, bytes):
-        # ── Step 1: Leggi encoding dichiarato nel prolog XML ─────────────
-        # Es: <?xml version='1.0' encoding='GB2312'?>
-        xml_prolog = contenuto_bytes[:300].decode('ascii', errors='ignore')
-        _enc_match = re.search(r'encoding=["\']([^"\']+)["\']', xml_prolog, re.IGNORECASE)
-        declared_enc = _enc_match.group(1).strip().lower() if _enc_match else None
-        if declared_enc:
-            logger.info(f"📄 Encoding dichiarato nel prolog XML: {declared_enc}")
-
-        # ── Step 2: Costruisci lista priorità encoding ────────────────────
-        # Prima il dichiarato (se non è UTF-8, già incluso sotto), poi UTF-8,
-        # poi Windows-1252 (comune fatture italiane su Windows), poi CJK, poi latin-1
-        encodings_to_try = []
-        if declared_enc and declared_enc not in ('utf-8', 'utf8', 'utf_8'):
-            encodings_to_try.append(declared_enc)
-        encodings_to_try.extend(['utf-8-sig', 'utf-8', 'cp1252', 'gb2312', 'gbk', 'big5', 'latin-1'])
-
-        contenuto = None
-        for encoding in encodings_to_try:
-            try:
-                contenuto = contenuto_bytes.decode(encoding)
-                logger.info(f"✅ File XML decodificato con encoding: {encoding}")
-                break
-            except (UnicodeDecodeError, LookupError):
-                continue
-
-        if contenuto is None:
-            # ── Step 3: Usa charset-normalizer per rilevamento automatico ─
-            try:
-                from charset_normalizer import from_bytes as _from_bytes
-                _result = _from_bytes(contenuto_bytes).best()
-                if _result:
-                    contenuto = str(_result)
-                    logger.info(f"✅ Encoding rilevato da charset-normalizer: {_result.encoding}")
-                else:
-                    raise ValueError("charset-normalizer non ha riconosciuto l'encoding")
-            except (ImportError, ValueError) as enc_err:
-                # Fallback finale: sostituisci caratteri non decodificabili
-                contenuto = contenuto_bytes.decode('utf-8', errors='replace')
-                logger.warning(f"⚠️ Encoding fallback UTF-8 con sostituzione: {enc_err}")
+        # Cascata encoding (prolog, UTF-8, cp1252, CJK, latin-1, charset-normalizer):
+        # la stessa usata come ripiego da parse_fattura.
+        contenuto = decodifica_bytes_xml(contenuto_bytes)
     else:
         contenuto = contenuto_bytes
 
@@ -726,6 +715,58 @@ def decodifica_xml_sicuro(contenuto_bytes) -> str:
     return contenuto
 
 
+def _categorizza_righe_preparate(
+    righe_preparate: list,
+    user_id: Optional[str],
+    fornitore: str,
+    pending_local_saves: list,
+    nome_file: str,
+) -> list:
+    """Categorizza in blocco le righe valide di una fattura.
+
+    Ritorna un esito (categoria, is_fallback) per riga, nello stesso ordine; None
+    per le righe da scartare. Se il batch solleva, si ricade sul percorso per riga
+    così un errore su UNA descrizione scarta solo quella riga, come prima.
+    """
+    from services.ai_service import categorizza_batch, categorizza_con_memoria
+
+    input_batch = [
+        {
+            'descrizione': prep['descrizione'],
+            'prezzo': prep['prezzo_unitario'],
+            'quantita': prep['quantita'],
+            'unita_misura': prep['unita_misura'],
+            'iva_percentuale': prep['aliquota_iva'],
+            'totale_riga': prep['totale_riga'],
+        }
+        for prep in righe_preparate
+    ]
+    try:
+        return categorizza_batch(
+            input_batch,
+            user_id=user_id,
+            fornitore=fornitore,
+            pending_local_saves=pending_local_saves,
+        )
+    except Exception as e:
+        logger.warning(f"{nome_file} - categorizzazione batch fallita, ripiego per riga: {str(e)[:100]}")
+
+    esiti: list = []
+    for prep, riga_batch in zip(righe_preparate, input_batch):
+        try:
+            esiti.append(categorizza_con_memoria(
+                user_id=user_id,
+                fornitore=fornitore,
+                pending_local_saves=pending_local_saves,
+                return_fallback_flag=True,
+                **riga_batch,
+            ))
+        except Exception as e:
+            logger.warning(f"{nome_file} - Riga {prep['idx']} skippata: {str(e)[:100]}")
+            esiti.append(None)
+    return esiti
+
+
 def estrai_dati_da_xml(file_caricato, user_id: str = None):
     """
     Estrae dati da fatture XML elettroniche italiane.
@@ -749,7 +790,6 @@ def estrai_dati_da_xml(file_caricato, user_id: str = None):
         # Import services solo quando necessario per evitare circular imports
         from services.ai_service import (
             carica_memoria_completa,
-            categorizza_con_memoria,
             descrizione_e_dubbia,
             enforce_no_unclassified_category,
             flush_pending_local_saves,
@@ -771,46 +811,22 @@ def estrai_dati_da_xml(file_caricato, user_id: str = None):
         
         contenuto_bytes = file_caricato.read()
 
-        # Encoding robusto (caratteri speciali, cinesi, ecc.) + validazione XXE
-        contenuto = decodifica_xml_sicuro(contenuto_bytes)
+        # Un solo passaggio expat: encoding dal prolog (ripiego sulla cascata
+        # storica), guard XXE, testata in forma xmltodict per gli estrattori
+        # fornitore/cessionario e il primo body gia' in record tipizzati.
+        fattura_pa = parse_fattura(contenuto_bytes, solo_primo_corpo=True)
+        fattura = fattura_pa.testata
+        corpo = fattura_pa.corpi[0] if fattura_pa.corpi else CorpoFattura()
 
-        doc = xmltodict.parse(contenuto)
-        
-        root_key = list(doc.keys())[0]
-        fattura = doc[root_key]
-        
-        data_documento = safe_get(
-            fattura,
-            ['FatturaElettronicaBody', 'DatiGenerali', 'DatiGeneraliDocumento', 'Data'],
-            default='N/A',
-            keep_list=False
-        )
+        data_documento = corpo.data or 'N/A'
 
-        totale_documento = _to_float_safe(
-            safe_get(
-                fattura,
-                ['FatturaElettronicaBody', 'DatiGenerali', 'DatiGeneraliDocumento', 'ImportoTotaleDocumento'],
-                default=None,
-                keep_list=False,
-            )
-        )
-
-        dati_riepilogo = safe_get(
-            fattura,
-            ['FatturaElettronicaBody', 'DatiBeniServizi', 'DatiRiepilogo'],
-            default=[],
-            keep_list=True,
-        )
-        if isinstance(dati_riepilogo, dict):
-            dati_riepilogo = [dati_riepilogo]
+        totale_documento = _to_float_safe(corpo.importo_totale)
 
         totale_imponibile = 0.0
         totale_iva = 0.0
-        for riepilogo in dati_riepilogo:
-            if not isinstance(riepilogo, dict):
-                continue
-            totale_imponibile += _to_float_safe(riepilogo.get('ImponibileImporto'), 0.0) or 0.0
-            totale_iva += _to_float_safe(riepilogo.get('Imposta'), 0.0) or 0.0
+        for imponibile_raw, imposta_raw in corpo.riepiloghi:
+            totale_imponibile += _to_float_safe(imponibile_raw, 0.0) or 0.0
+            totale_iva += _to_float_safe(imposta_raw, 0.0) or 0.0
 
         totale_imponibile = round(totale_imponibile, 2)
         totale_iva = round(totale_iva, 2)
@@ -825,12 +841,7 @@ def estrai_dati_da_xml(file_caricato, user_id: str = None):
         # TD01 = Fattura, TD02 = Acconto, TD04 = Nota di Credito,
         # TD05 = Nota di Debito, TD06 = Parcella, TD07 = Autofattura
         _TIPI_DOCUMENTO_VALIDI = {'TD01', 'TD02', 'TD04', 'TD05', 'TD06', 'TD07', 'TD16', 'TD17', 'TD18', 'TD19', 'TD20', 'TD24', 'TD25', 'TD26', 'TD27'}
-        tipo_documento_raw = safe_get(
-            fattura,
-            ['FatturaElettronicaBody', 'DatiGenerali', 'DatiGeneraliDocumento', 'TipoDocumento'],
-            default='TD01',
-            keep_list=False
-        )
+        tipo_documento_raw = corpo.tipo_documento or 'TD01'
         tipo_documento = str(tipo_documento_raw).upper().strip()
         if tipo_documento not in _TIPI_DOCUMENTO_VALIDI:
             logger.warning(f"⚠️ TipoDocumento sconosciuto: '{tipo_documento_raw}', fallback a TD01")
@@ -839,12 +850,7 @@ def estrai_dati_da_xml(file_caricato, user_id: str = None):
         if is_nota_credito:
             logger.info(f"📋 NOTA DI CREDITO rilevata (TipoDocumento={tipo_documento})")
 
-        numero_documento = safe_get(
-            fattura,
-            ['FatturaElettronicaBody', 'DatiGenerali', 'DatiGeneraliDocumento', 'Numero'],
-            default=None,
-            keep_list=False,
-        )
+        numero_documento = corpo.numero
         if numero_documento is not None:
             numero_documento = str(numero_documento).strip() or None
 
@@ -856,7 +862,7 @@ def estrai_dati_da_xml(file_caricato, user_id: str = None):
         )
         piva_cedente = _normalizza_piva_cedente(piva_cedente_raw)
 
-        pagamento_info = _estrai_info_pagamento_xml(fattura, tipo_documento)
+        pagamento_info = _estrai_info_pagamento_xml(corpo, tipo_documento)
         scadenza_xml = pagamento_info.get('scadenza_xml')
         giorni_termini_xml = pagamento_info.get('giorni_termini_xml')
         
@@ -871,8 +877,6 @@ def estrai_dati_da_xml(file_caricato, user_id: str = None):
         if piva_cessionario:
             logger.info(f"📋 P.IVA Cessionario estratta: {piva_cessionario}")
         
-        body = safe_get(fattura, ['FatturaElettronicaBody'], default={}, keep_list=False)
-
         # ============================================================
         # ESTRAZIONE DATA CONSEGNA DA DatiDDT (fatture differite TD24)
         # ============================================================
@@ -885,48 +889,26 @@ def estrai_dati_da_xml(file_caricato, user_id: str = None):
         is_td24 = (tipo_documento == 'TD24')
 
         if is_td24:
-            dati_generali = safe_get(body, ['DatiGenerali'], default={}, keep_list=False)
-            dati_ddt_raw = dati_generali.get('DatiDDT') if isinstance(dati_generali, dict) else None
-            if dati_ddt_raw is not None:
-                if isinstance(dati_ddt_raw, dict):
-                    dati_ddt_raw = [dati_ddt_raw]
-                if isinstance(dati_ddt_raw, list):
-                    for ddt_block in dati_ddt_raw:
-                        if not isinstance(ddt_block, dict):
-                            continue
-                        data_ddt = str(ddt_block.get('DataDDT') or '').strip()
-                        if not data_ddt:
-                            continue
-                        rif_linee = ddt_block.get('RiferimentoNumeroLinea')
-                        if rif_linee is None:
-                            # Nessun riferimento riga → vale per tutte le righe
-                            _ddt_global_date = data_ddt
-                        else:
-                            if not isinstance(rif_linee, list):
-                                rif_linee = [rif_linee]
-                            for num in rif_linee:
-                                try:
-                                    _ddt_date_map[int(num)] = data_ddt
-                                except (ValueError, TypeError):
-                                    pass
+            for data_ddt, rif_linee in corpo.ddt:
+                data_ddt = str(data_ddt or '').strip()
+                if not data_ddt:
+                    continue
+                if not rif_linee:
+                    # Nessun riferimento riga → vale per tutte le righe
+                    _ddt_global_date = data_ddt
+                else:
+                    for num in rif_linee:
+                        try:
+                            _ddt_date_map[int(num)] = data_ddt
+                        except (ValueError, TypeError):
+                            pass
             if _ddt_date_map or _ddt_global_date:
                 logger.info(
                     f"📅 TD24 DatiDDT: {len(_ddt_date_map)} righe mappate"
                     + (f", data globale={_ddt_global_date}" if _ddt_global_date else "")
                 )
 
-        linee = safe_get(
-            body, 
-            ['DatiBeniServizi', 'DettaglioLinee'], 
-            default=[],
-            keep_list=True
-        )
-        
-        if not linee:
-            linee = safe_get(body, ['DettaglioLinee'], default=[], keep_list=True)
-        
-        if isinstance(linee, dict):
-            linee = [linee]
+        linee = corpo.righe()
 
         # ============================================================
         # NOTA DI CREDITO (TD04): strategia di segno ancorata alla testata
@@ -951,8 +933,8 @@ def estrai_dati_da_xml(file_caricato, user_id: str = None):
         nc_inverti_in_blocco = False
         if is_nota_credito:
             _ha_riga_negativa = any(
-                (_to_float_safe(_r.get('PrezzoTotale'), 0.0) or 0.0) < 0
-                for _r in linee if isinstance(_r, dict)
+                (_to_float_safe(_r.prezzo_totale, 0.0) or 0.0) < 0
+                for _r in linee
             )
             nc_inverti_in_blocco = not _ha_riga_negativa
             logger.info(
@@ -964,30 +946,28 @@ def estrai_dati_da_xml(file_caricato, user_id: str = None):
 
         righe_prodotti = []
         # PROP-1: buffer per batch upsert auto-keyword in memoria locale.
-        # Riempito da categorizza_con_memoria, flushato a fine loop con UNA sola
+        # Riempito da categorizza_batch, flushato a fine elaborazione con UNA sola
         # SELECT bulk + UNA sola UPSERT batch (vs N+1 query per riga).
         _pending_local_saves: list = []
+        righe_preparate: list = []
         for idx, riga in enumerate(linee, start=1):
-            if not isinstance(riga, dict):
-                continue
-            
             try:
                 # ============================================================
                 # STEP 2: VALIDAZIONE E SKIP RIGHE INVALIDE
                 # ============================================================
                 # Estrai valori base per validazione
-                descrizione_raw = riga.get('Descrizione', '')
+                descrizione_raw = riga.descrizione or ''
                 
                 # Pulisci caratteri corrotti (encoding errato, caratteri cinesi mal encodati)
                 if descrizione_raw:
                     descrizione_raw = pulisci_caratteri_corrotti(descrizione_raw)
                 
-                quantita_raw = riga.get('Quantita')
-                prezzo_totale_raw = riga.get('PrezzoTotale')
+                quantita_raw = riga.quantita
+                prezzo_totale_raw = riga.prezzo_totale
                 # _to_float_safe gestisce la virgola decimale e i None: con float()
                 # diretto un "1,50" (XML non conforme / p7m ricostruito a byte) sollevava
                 # ValueError -> l'except piu' in basso scartava silenziosamente la riga.
-                prezzo_base = _to_float_safe(riga.get('PrezzoUnitario'), 0.0)
+                prezzo_base = _to_float_safe(riga.prezzo_unitario, 0.0)
                 totale_riga = _to_float_safe(prezzo_totale_raw, 0.0)
                 xml_has_explicit_zero_total = prezzo_totale_raw not in (None, '') and abs(totale_riga) < 1e-9
                 
@@ -1005,22 +985,15 @@ def estrai_dati_da_xml(file_caricato, user_id: str = None):
                 # ESTRAZIONE SCONTO MAGGIORAZIONE XML
                 # ============================================================
                 sconto_percentuale = 0.0
-                sconto_maggiorazione = riga.get('ScontoMaggiorazione')
-                if sconto_maggiorazione:
-                    # Può essere dict singolo o lista
-                    if isinstance(sconto_maggiorazione, dict):
-                        sconto_maggiorazione = [sconto_maggiorazione]
-                    if isinstance(sconto_maggiorazione, list):
-                        for sm in sconto_maggiorazione:
-                            tipo_sm = sm.get('Tipo', 'SC')  # SC=Sconto, MG=Maggiorazione
-                            # _to_float_safe: la percentuale può arrivare con virgola
-                            # decimale ("5,00") o malformata; float() crasherebbe l'intero
-                            # parsing della fattura. Fallback 0 = nessuno sconto.
-                            perc = _to_float_safe(sm.get('Percentuale'), 0.0) or 0.0
-                            if tipo_sm == 'SC':
-                                sconto_percentuale += perc
-                            elif tipo_sm == 'MG':
-                                sconto_percentuale -= perc  # Maggiorazione riduce lo sconto
+                for tipo_sm, perc_raw in riga.sconti:  # Tipo: SC=Sconto, MG=Maggiorazione
+                    # _to_float_safe: la percentuale può arrivare con virgola
+                    # decimale ("5,00") o malformata; float() crasherebbe l'intero
+                    # parsing della fattura. Fallback 0 = nessuno sconto.
+                    perc = _to_float_safe(perc_raw, 0.0) or 0.0
+                    if tipo_sm == 'SC':
+                        sconto_percentuale += perc
+                    elif tipo_sm == 'MG':
+                        sconto_percentuale -= perc  # Maggiorazione riduce lo sconto
                 
                 # MARK FOR REVIEW: Prezzo zero o mancante (potrebbe essere omaggio, dicitura, o servizio gratuito)
                 needs_review_flag = False
@@ -1082,23 +1055,14 @@ def estrai_dati_da_xml(file_caricato, user_id: str = None):
                     descrizione = descrizione[:150] + "..."
                 
                 # Codice articolo
-                codice_articolo = ""
-                codice_articolo_raw = riga.get('CodiceArticolo', [])
-                if isinstance(codice_articolo_raw, list) and len(codice_articolo_raw) > 0:
-                    _first_codice = codice_articolo_raw[0]
-                    # XML malformato (p7m ricostruito) puo' dare una lista di stringhe
-                    # invece che di dict: .get() su una stringa solleverebbe AttributeError
-                    # e l'except a valle scarterebbe l'intera riga.
-                    if isinstance(_first_codice, dict):
-                        codice_articolo = _first_codice.get('CodiceValore', '')
-                elif isinstance(codice_articolo_raw, dict):
-                    codice_articolo = codice_articolo_raw.get('CodiceValore', '')
+                # CodiceValore del primo CodiceArticolo ('' se assente)
+                codice_articolo = riga.codice_articolo
                 
                 # Estrai e normalizza unità di misura
-                unita_misura_raw = riga.get('UnitaMisura', '')
+                unita_misura_raw = riga.unita_misura or ''
                 unita_misura = normalizza_unita_misura(unita_misura_raw)
                 
-                aliquota_iva = _to_float_safe(riga.get('AliquotaIVA'), 0.0)
+                aliquota_iva = _to_float_safe(riga.aliquota_iva, 0.0)
                 
                 # Calcola prezzo effettivo (include sconti)
                 # Usa abs() per gestire correttamente quantità negative (resi)
@@ -1118,23 +1082,55 @@ def estrai_dati_da_xml(file_caricato, user_id: str = None):
                     sconto_percentuale = round(((abs(prezzo_base) - abs(prezzo_unitario)) / abs(prezzo_base)) * 100, 2)
                 
 
-                # Auto-categorizzazione
-                # return_fallback_flag=True: distinguiamo un vero match (memoria/regole/
-                # fornitore/UM/dizionario) da un fallback forzato a SERVIZI E CONSULENZE.
-                # Il fallback NON va trattato come classificato: va passato all'AI in
-                # riconciliazione post-upload e marcato needs_review.
-                categoria_finale, fallback_forzato = categorizza_con_memoria(
-                    descrizione=descrizione,
-                    prezzo=prezzo_unitario,
-                    quantita=quantita,
-                    user_id=current_user_id,
-                    fornitore=fornitore,
-                    unita_misura=unita_misura,
-                    iva_percentuale=aliquota_iva,
-                    pending_local_saves=_pending_local_saves,
-                    return_fallback_flag=True,
-                    totale_riga=totale_riga,
-                )
+                # La categorizzazione NON avviene qui riga per riga: le righe valide
+                # vengono raccolte e categorizzate in blocco dopo il loop
+                # (categorizza_batch: decisioni fornitore/memoria una volta per
+                # fattura, normalizzazione una volta per descrizione distinta).
+                righe_preparate.append({
+                    'idx': idx,
+                    'riga': riga,
+                    'descrizione_raw': descrizione_raw,
+                    'descrizione': descrizione,
+                    'quantita': quantita,
+                    'unita_misura': unita_misura,
+                    'aliquota_iva': aliquota_iva,
+                    'prezzo_unitario': prezzo_unitario,
+                    'totale_riga': totale_riga,
+                    'sconto_percentuale': sconto_percentuale,
+                    'codice_articolo': codice_articolo,
+                    'needs_review_flag': needs_review_flag,
+                })
+            except Exception as e:
+                logger.warning(f"{file_caricato.name} - Riga {idx} skippata: {str(e)[:100]}")
+                continue
+
+        # Auto-categorizzazione
+        # fallback_forzato distingue un vero match (memoria/regole/fornitore/UM/
+        # dizionario) da un fallback forzato a SERVIZI E CONSULENZE. Il fallback NON
+        # va trattato come classificato: va passato all'AI in riconciliazione
+        # post-upload e marcato needs_review.
+        categorie_righe = _categorizza_righe_preparate(
+            righe_preparate, current_user_id, fornitore, _pending_local_saves, file_caricato.name
+        )
+
+        for prep, esito in zip(righe_preparate, categorie_righe):
+            idx = prep['idx']
+            if esito is None:
+                continue
+            try:
+                riga = prep['riga']
+                descrizione_raw = prep['descrizione_raw']
+                descrizione = prep['descrizione']
+                quantita = prep['quantita']
+                unita_misura = prep['unita_misura']
+                aliquota_iva = prep['aliquota_iva']
+                prezzo_unitario = prep['prezzo_unitario']
+                totale_riga = prep['totale_riga']
+                sconto_percentuale = prep['sconto_percentuale']
+                codice_articolo = prep['codice_articolo']
+                needs_review_flag = prep['needs_review_flag']
+                categoria_finale, fallback_forzato = esito
+
                 categoria_finale, _enforce_fallback = enforce_no_unclassified_category(
                     categoria_finale,
                     descrizione,
@@ -1216,7 +1212,7 @@ def estrai_dati_da_xml(file_caricato, user_id: str = None):
                     # al massimo la data di consegna della riga; lasciar risalire
                     # l'eccezione farebbe scartare l'intera riga dal totale documento.
                     try:
-                        _num_linea_xml = int(riga.get('NumeroLinea') or 0)
+                        _num_linea_xml = int(riga.numero_linea or 0)
                     except (TypeError, ValueError):
                         _num_linea_xml = 0
                     _riga_data_consegna = _ddt_date_map.get(_num_linea_xml) or _ddt_date_map.get(idx)
@@ -1382,31 +1378,37 @@ def estrai_dati_da_scontrino_vision(file_caricato, openai_client=None):
         # � Admin e impersonazione bypassano i limiti Vision per test operativi
         ristorante_id = st.session_state.get('ristorante_id')
         _is_unrestricted_admin = bool(st.session_state.get('user_is_admin', False) or st.session_state.get('impersonating', False))
+        # Prenotazione atomica (services/ai_quota): due upload concorrenti non
+        # possono superare insieme VISION_DAILY_LIMIT. Se il file si scarta
+        # prima della chiamata l'unita' torna al lotto.
+        _prenotazione_vision = None
         if ristorante_id and not _is_unrestricted_admin:
             try:
-                from services.ai_cost_service import get_daily_quota_status
-                quota = get_daily_quota_status(
-                    ristorante_id=ristorante_id,
-                    operation_types=['pdf', 'vision'],
-                    daily_limit=VISION_DAILY_LIMIT,
-                )
-                if quota['is_exceeded']:
+                from services import ai_quota
+                _prenotazione_vision = ai_quota.riserva(ristorante_id, 'vision', n=1, limite=VISION_DAILY_LIMIT)
+                if not _prenotazione_vision.concessa:
                     logger.warning(
                         "🔒 Quota Vision superata per ristorante %s: %s/%s oggi",
                         ristorante_id,
-                        quota['used'],
-                        quota['limit'],
+                        _prenotazione_vision.usati,
+                        _prenotazione_vision.limite,
                     )
                     raise VisionDailyLimitExceededError(
-                        used=int(quota['used']),
-                        limit=int(quota['limit']),
+                        used=int(_prenotazione_vision.usati),
+                        limit=int(_prenotazione_vision.limite),
                         ristorante_id=ristorante_id,
                     )
             except VisionDailyLimitExceededError:
                 raise
             except Exception as quota_err:
+                _prenotazione_vision = None
                 logger.warning(f"⚠️ Errore check quota Vision: {quota_err} — proseguo senza blocco")
 
+        def _rilascia_quota_vision():
+            if _prenotazione_vision is not None:
+                from services import ai_quota
+                ai_quota.conferma(_prenotazione_vision, 0)
+
         # I-1: Limite dimensione immagini Vision — file >20 MB supera il massimo OpenAI (~20 MB inline)
         _MAX_VISION_BYTES = 20 * 1024 * 1024  # 20 MB
         _file_size = getattr(file_caricato, 'size', None)
@@ -1423,11 +1425,13 @@ def estrai_dati_da_scontrino_vision(file_caricato, openai_client=None):
                 file_caricato.name, _file_size // (1024 * 1024)
             )
             _ui_msg("error", f"❌ {file_caricato.name} supera il limite di 20 MB per l'analisi Vision.")
+            _rilascia_quota_vision()
             return []
 
         file_caricato.seek(0)
         base64_image = converti_in_base64(file_caricato, file_caricato.name)
         if not base64_image:
+            _rilascia_quota_vision()
             return []
         
         prompt = """Sei un esperto contabile per ristoranti italiani. Analizza questo documento (scontrino/fattura) ed estrai i dati.
@@ -2100,10 +2104,14 @@ def salva_fattura_processata(nome_file: str, dati_prodotti: List[Dict],
                     from services.daily_briefing_service import invalidate_today_briefing
                     invalidate_today_briefing(str(user_id), str(ristorante_id), supabase_client)
                     # Le nuove fatture cambiano food cost / spese della card KPI Home
-                    # (cache TTL 2 min): invalido cosi' i conti riflettono subito
-                    # l'upload. Best-effort come sopra.
-                    from services.fastapi_worker import _invalidate_home_kpi_cache
+                    # e le righe di Fatture/Prezzi: invalido cosi' i conti riflettono
+                    # subito l'upload. Dal queue-worker l'invalidazione arriva al
+                    # processo web via cache_bus. Best-effort come sopra.
+                    from services.fastapi_worker import (
+                        _invalidate_fatture_rows_cache, _invalidate_home_kpi_cache,
+                    )
                     _invalidate_home_kpi_cache(str(ristorante_id))
+                    _invalidate_fatture_rows_cache(str(ristorante_id))
                 except Exception as briefing_exc:
                     logger.warning("invalidazione briefing post-upload fallita: %s", briefing_exc)
 
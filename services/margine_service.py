@@ -17,6 +17,7 @@ except ImportError:
 from datetime import datetime, timezone
 from config.logger_setup import get_logger
 from config.constants import CATEGORIE_FOOD, CATEGORIE_SPESE_GENERALI, KPI_SOGLIE
+from utils.fan_out import in_parallelo
 from utils.streamlit_compat import make_cache as _make_cache
 
 logger = get_logger('margine_service')
@@ -119,6 +120,11 @@ def calcola_costi_automatici_per_anno(user_id: str, ristorante_id: str, anno: in
         # Assicurati che totale_riga sia numerico
         df['totale_riga'] = pd.to_numeric(df['totale_riga'], errors='coerce').fillna(0)
 
+        # Categoria vuota (o NULL) fuori dal MOL, come nella RPC sul cubo
+        # (costi_automatici_mensili) e in _calcola_costi_auto_per_periodo:
+        # altrimenti lo stesso mese cambierebbe a seconda di chi risponde.
+        df = df[df['categoria'].fillna('') != '']
+
         # Split F&B vs Spese — CATCH-ALL come la pagina Margini
         # (_calcola_costi_auto_per_periodo): FOOD = ogni costo che NON è spese
         # generali e non è "NOTE E DICITURE". Usare la lista esplicita
@@ -163,6 +169,9 @@ def calcola_costi_automatici_per_anno_sql(user_id: str, ristorante_id: str, anno
     (Storicamente questa variante nacque anche perche' @_make_cache non cachava
     nulla senza Streamlit; oggi cacha davvero, ma l'aggregazione lato DB resta
     comunque la strada giusta e questa funzione la strada usata in produzione.)
+    Dalla migration 20261005100000 la RPC legge il cubo costi_mensili_cubo,
+    mantenuto dai trigger su fatture: una lettura indicizzata per sede e anno,
+    indipendente dal numero di righe del cliente.
 
     Fallback: se la RPC fallisce per qualsiasi motivo, ricade sul metodo pandas
     storico — il calcolo dei margini non deve mai rompersi.
@@ -205,10 +214,13 @@ def calcola_costi_automatici_gruppo_sql(user_id: str, ristorante_ids: list, anno
     in UNA query (RPC costi_automatici_mensili_gruppo). Serve alla Sintesi di catena
     per ricalcolare i costi LIVE senza dipendere dallo snapshot margini_mensili e
     senza fare N chiamate per sede (regola catena: aggregazione SQL, mai loop righe).
+    Come la RPC per sede, legge il cubo costi_mensili_cubo.
 
     Ritorna {ristorante_id(str): (dict_fb {mese: €}, dict_spese {mese: €})}.
     Le sedi/mesi senza righe semplicemente non compaiono. Fallback per-sede sul
-    metodo storico se la RPC fallisce, così la Sintesi non si rompe mai.
+    metodo storico se la RPC fallisce, così la Sintesi non si rompe mai: le
+    chiamate per sede vanno in parallelo con un pool limitato (utils/fan_out),
+    altrimenti con 15+ sedi il fallback costa 15 round-trip in fila.
     """
     ids = [str(r) for r in (ristorante_ids or [])]
     if not ids:
@@ -242,10 +254,11 @@ def calcola_costi_automatici_gruppo_sql(user_id: str, ristorante_ids: list, anno
         logger.warning(
             f"⚠️ RPC costi_automatici_mensili_gruppo fallita (anno {anno}), fallback per-sede: {e}"
         )
-        return {
-            rid: calcola_costi_automatici_per_anno_sql(user_id, rid, anno)
-            for rid in ids
-        }
+        per_sede = in_parallelo(
+            lambda rid: calcola_costi_automatici_per_anno_sql(user_id, rid, anno),
+            ids, nome="costi-auto-gruppo",
+        )
+        return dict(zip(ids, per_sede))
 
 
 # ============================================
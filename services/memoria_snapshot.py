@@ -0,0 +1,380 @@
+"""Snapshot condiviso (file mappato in memoria) della memoria GLOBALE di classificazione.
+
+Problema: `ai_service.carica_memoria_completa` costruisce `_memoria_cache` PER
+PROCESSO paginando tutta `prodotti_master`, `classificazioni_manuali` e
+`brand_ambigui`. Con WORKER_WEB_CONCURRENCY=4 lo fanno 4 processi, e dopo ogni
+bump di `cache_version` (o alla scadenza del TTL) lo rifanno tutti insieme: N
+scansioni complete via PostgREST nello stesso istante, N copie dei dict in RAM.
+
+Soluzione: il PRIMO processo che trova la cache scaduta scarica le tabelle e
+scrive un file immutabile `memoria_v<version>.snap` nella directory locale; gli
+altri aspettano il file e lo mappano in sola lettura (mmap). Le pagine del file
+stanno nella page cache del kernel una volta sola, condivise fra i processi.
+
+Formato (tutto nativo della macchina, il file non viaggia fra host):
+
+    MAGIC (8 byte) | lunghezza header (uint32) | header JSON | tabelle
+
+Ogni tabella e' un indice a chiavi ORDINATE (byte UTF-8): un array di offset
+uint32 (n+1), un array di codici valore uint16 (n) e il blob delle chiavi. Il
+lookup e' una ricerca binaria sul file: O(log n) confronti, zero dict in RAM.
+I valori sono indici in una tabella delle categorie (poche decine di stringhe)
+nell'header; per `classificazioni_manuali` il bit basso porta `is_dicitura`.
+
+Coordinamento fra processi: file di lock creato con O_EXCL (portabile anche su
+Windows in sviluppo). Chi non prende il lock aspetta il file per al massimo
+`attesa_s`; se non arriva, ritorna None e il chiamante scarica da solo come
+prima — lo snapshot e' un'ottimizzazione, mai un punto di blocco.
+
+Attivazione: SOLO se `MEMORIA_SNAPSHOT_DIR` e' impostata (in produzione nel
+servizio "worker"). Senza, `ai_service` resta sul caricamento per-processo: i
+test e gli script non scrivono mai file fuori dal loro controllo.
+
+Nota: "worker" e "queue-worker" sono container Railway separati, quindi non si
+condividono il file; lo condividono i processi uvicorn dello stesso container.
+"""
+
+from __future__ import annotations
+
+import glob
+import json
+import mmap
+import os
+import time
+from array import array
+from collections.abc import MutableMapping
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+from config.logger_setup import get_logger
+
+logger = get_logger('memoria_snapshot')
+
+_MAGIC = b"OFXMEM1\n"
+_ENV_DIR = "MEMORIA_SNAPSHOT_DIR"
+
+# Tabelle categoria-valore e tabella con flag (classificazioni_manuali).
+TABELLE_CATEGORIA = ("prodotti_master", "prodotti_master_canon", "prodotti_master_hint")
+TABELLA_MANUALI = "classificazioni_manuali"
+
+# Un lock piu' vecchio di cosi' e' di un processo morto a meta' build.
+_LOCK_STALE_S = 120.0
+_SNAPSHOT_DA_TENERE = 2
+
+
+def directory_snapshot() -> Optional[str]:
+    """Directory degli snapshot, o None se la funzione e' disattivata."""
+    d = (os.getenv(_ENV_DIR) or "").strip()
+    return d or None
+
+
+def percorso_snapshot(version: int, directory: Optional[str] = None) -> Optional[str]:
+    d = directory or directory_snapshot()
+    if not d:
+        return None
+    return os.path.join(d, f"memoria_v{int(version)}.snap")
+
+
+class _TabellaMappata(MutableMapping):
+    """Mapping su una tabella a chiavi ordinate dentro il file.
+
+    Supporta tutto cio' che `ai_service` usa sui dict della memoria: `in`,
+    `[]`, `.get()`, `len()` e la verita' (`or {}`). Il file resta in sola
+    lettura: le scritture (delta incrementale di ai_service) finiscono in un
+    piccolo overlay per processo (`_sopra` = chiavi aggiunte/modificate,
+    `_tolte` = chiavi del file rimosse), cosi' patchare una voce non costa la
+    copia dell'intera tabella in un dict.
+    """
+
+    __slots__ = ("_buf", "_offs", "_vals", "_keys_at", "_n", "_decodifica", "_sopra", "_tolte")
+
+    def __init__(self, buf, offs, vals, keys_at: int, decodifica: Callable[[int], Any]) -> None:
+        self._buf = buf
+        self._offs = offs
+        self._vals = vals
+        self._keys_at = keys_at
+        self._n = len(vals)
+        self._decodifica = decodifica
+        self._sopra: Dict[str, Any] = {}
+        self._tolte: set = set()
+
+    def _indice(self, key: Any) -> int:
+        if not isinstance(key, str):
+            return -1
+        try:
+            k = key.encode("utf-8")
+        except UnicodeEncodeError:
+            return -1
+        buf, offs, base = self._buf, self._offs, self._keys_at
+        lo, hi = 0, self._n
+        while lo < hi:
+            mid = (lo + hi) >> 1
+            cur = buf[base + offs[mid]:base + offs[mid + 1]]
+            if cur < k:
+                lo = mid + 1
+            elif cur > k:
+                hi = mid
+            else:
+                return mid
+        return -1
+
+    def _nel_file(self, key: Any) -> bool:
+        return key not in self._tolte and self._indice(key) >= 0
+
+    def __getitem__(self, key: Any) -> Any:
+        if self._sopra and isinstance(key, str) and key in self._sopra:
+            return self._sopra[key]
+        if key in self._tolte:
+            raise KeyError(key)
+        i = self._indice(key)
+        if i < 0:
+            raise KeyError(key)
+        return self._decodifica(self._vals[i])
+
+    def __contains__(self, key: Any) -> bool:
+        if self._sopra and isinstance(key, str) and key in self._sopra:
+            return True
+        return self._nel_file(key)
+
+    def __setitem__(self, key: str, value: Any) -> None:
+        self._sopra[key] = value
+        self._tolte.discard(key)
+
+    def __delitem__(self, key: Any) -> None:
+        trovata = isinstance(key, str) and self._sopra.pop(key, _ASSENTE) is not _ASSENTE
+        if self._nel_file(key):
+            self._tolte.add(key)
+            trovata = True
+        if not trovata:
+            raise KeyError(key)
+
+    def __len__(self) -> int:
+        nuove = sum(1 for k in self._sopra if self._indice(k) < 0)
+        return self._n - len(self._tolte) + nuove
+
+    def __iter__(self) -> Iterator[str]:
+        buf, offs, base = self._buf, self._offs, self._keys_at
+        sopra, tolte = self._sopra, self._tolte
+        for i in range(self._n):
+            k = bytes(buf[base + offs[i]:base + offs[i + 1]]).decode("utf-8")
+            if k not in sopra and k not in tolte:
+                yield k
+        yield from list(sopra)
+
+
+_ASSENTE = object()
+
+
+def _allinea(n: int, a: int = 4) -> int:
+    return (n + a - 1) // a * a
+
+
+def scrivi_snapshot(path: str, version: int, parti: Dict[str, Any], built_at: Optional[float] = None) -> None:
+    """Scrive lo snapshot in modo atomico (file temporaneo + os.replace).
+
+    `parti` ha le chiavi di TABELLE_CATEGORIA (dict descrizione->categoria),
+    TABELLA_MANUALI (dict descrizione->{categoria, is_dicitura}) e
+    'brand_ambigui' (set). Le sezioni assenti sono scritte vuote.
+    """
+    categorie: List[Any] = []
+    indice_cat: Dict[Any, int] = {}
+
+    def _codice(cat: Any) -> int:
+        i = indice_cat.get(cat)
+        if i is None:
+            i = len(categorie)
+            indice_cat[cat] = i
+            categorie.append(cat)
+        return i
+
+    tabelle_raw: List[Tuple[str, List[Tuple[bytes, int]]]] = []
+    for nome in TABELLE_CATEGORIA:
+        voci = [(str(k).encode("utf-8"), _codice(v)) for k, v in (parti.get(nome) or {}).items()]
+        tabelle_raw.append((nome, voci))
+    voci_manuali = [
+        (str(k).encode("utf-8"), (_codice(v.get("categoria")) << 1) | (1 if v.get("is_dicitura") else 0))
+        for k, v in (parti.get(TABELLA_MANUALI) or {}).items()
+    ]
+    tabelle_raw.append((TABELLA_MANUALI, voci_manuali))
+    if len(categorie) > 0x7FFF:
+        raise ValueError(f"troppe categorie distinte per lo snapshot: {len(categorie)}")
+
+    # Layout: calcolo gli offset relativi all'inizio della sezione tabelle.
+    sezioni: List[bytes] = []
+    meta_tabelle: Dict[str, Dict[str, int]] = {}
+    pos = 0
+    for nome, voci in tabelle_raw:
+        voci.sort(key=lambda kv: kv[0])
+        offs = array("I", [0])
+        vals = array("H")
+        blob = bytearray()
+        for k, v in voci:
+            blob += k
+            offs.append(len(blob))
+            vals.append(v)
+        b_offs, b_vals = offs.tobytes(), vals.tobytes()
+        meta = {"n": len(voci), "offs_at": pos}
+        pos = _allinea(pos + len(b_offs))
+        meta["vals_at"] = pos
+        pos = _allinea(pos + len(b_vals))
+        meta["keys_at"] = pos
+        pos = _allinea(pos + len(blob))
+        meta_tabelle[nome] = meta
+        for b in (b_offs, b_vals, bytes(blob)):
+            sezioni.append(b + b"\0" * (_allinea(len(b)) - len(b)))
+
+    header = json.dumps({
+        "version": int(version),
+        "built_at": float(built_at if built_at is not None else time.time()),
+        "categorie": categorie,
+        "brand_ambigui": sorted(parti.get("brand_ambigui") or ()),
+        "tabelle": meta_tabelle,
+    }, ensure_ascii=False).encode("utf-8")
+    prefisso = _MAGIC + len(header).to_bytes(4, "little") + header
+    prefisso += b"\0" * (_allinea(len(prefisso)) - len(prefisso))
+
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(prefisso)
+        for s in sezioni:
+            f.write(s)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+def apri_snapshot(path: str, max_eta_s: Optional[float] = None) -> Optional[Tuple[Dict[str, Any], float]]:
+    """Mappa lo snapshot in sola lettura. Ritorna (parti, built_at) o None se il
+    file manca, e' corrotto o piu' vecchio di `max_eta_s`."""
+    try:
+        with open(path, "rb") as f:
+            buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError):
+        return None
+    try:
+        if buf[:len(_MAGIC)] != _MAGIC:
+            raise ValueError("magic non valido")
+        h_len = int.from_bytes(buf[len(_MAGIC):len(_MAGIC) + 4], "little")
+        h_start = len(_MAGIC) + 4
+        header = json.loads(bytes(buf[h_start:h_start + h_len]).decode("utf-8"))
+        built_at = float(header["built_at"])
+        if max_eta_s is not None and (time.time() - built_at) > max_eta_s:
+            buf.close()
+            return None
+        base = _allinea(h_start + h_len)
+        categorie = header["categorie"]
+        mv = memoryview(buf)
+
+        def _tabella(nome: str, decodifica: Callable[[int], Any]) -> _TabellaMappata:
+            m = header["tabelle"][nome]
+            n = int(m["n"])
+            offs = mv[base + m["offs_at"]:base + m["offs_at"] + 4 * (n + 1)].cast("I")
+            vals = mv[base + m["vals_at"]:base + m["vals_at"] + 2 * n].cast("H")
+            return _TabellaMappata(buf, offs, vals, base + m["keys_at"], decodifica)
+
+        parti: Dict[str, Any] = {
+            nome: _tabella(nome, categorie.__getitem__) for nome in TABELLE_CATEGORIA
+        }
+        parti[TABELLA_MANUALI] = _tabella(
+            TABELLA_MANUALI,
+            lambda c: {"categoria": categorie[c >> 1], "is_dicitura": bool(c & 1)},
+        )
+        # Set piccolo e MUTABILE per processo (ai_service ci aggiunge brand al volo).
+        parti["brand_ambigui"] = set(header.get("brand_ambigui") or ())
+        return parti, built_at
+    except Exception as e:
+        logger.warning(f"Snapshot memoria illeggibile ({os.path.basename(path)}), ignorato: {e}")
+        try:
+            buf.close()
+        except Exception:
+            pass
+        return None
+
+
+def _pulisci_vecchi(path: str) -> None:
+    """Tiene solo gli ultimi snapshot. Su Linux rimuovere un file ancora mappato da
+    un altro processo e' sicuro (la mappatura resta valida); su Windows fallisce e
+    lo lasciamo al giro dopo."""
+    d = os.path.dirname(path)
+    files = sorted(glob.glob(os.path.join(d, "memoria_v*.snap")), key=os.path.getmtime, reverse=True)
+    for vecchio in files[_SNAPSHOT_DA_TENERE:]:
+        try:
+            os.remove(vecchio)
+        except OSError:
+            pass
+
+
+def carica_o_costruisci(
+    version: int,
+    costruisci: Callable[[], Tuple[Dict[str, Any], bool]],
+    max_eta_s: float,
+    attesa_s: float = 30.0,
+    directory: Optional[str] = None,
+) -> Optional[Tuple[Dict[str, Any], float]]:
+    """Ritorna la memoria globale per `version`: dallo snapshot se c'e', altrimenti
+    la costruisce UN solo processo (gli altri aspettano il file).
+
+    `costruisci` ritorna (parti, completa). Se completa=False (una query fallita)
+    le parti vengono usate da questo processo ma NON scritte su file: uno
+    snapshot parziale verrebbe servito a tutti gli altri fino al TTL.
+
+    Ritorna (parti, built_at) oppure None se lo snapshot non e' disponibile entro
+    `attesa_s`: in quel caso il chiamante carica per conto suo.
+    """
+    path = percorso_snapshot(version, directory)
+    if not path:
+        return None
+    aperto = apri_snapshot(path, max_eta_s)
+    if aperto is not None:
+        return aperto
+
+    lock = f"{path}.lock"
+    scadenza = time.monotonic() + attesa_s
+    while True:
+        try:
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+            fd = os.open(lock, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            fd = None
+        except OSError as e:
+            logger.warning(f"Snapshot memoria: lock non creabile ({e}), caricamento per-processo")
+            return None
+
+        if fd is not None:
+            try:
+                os.close(fd)
+                # Ricontrollo: un altro processo puo' aver finito fra il mio primo
+                # tentativo di apertura e la presa del lock.
+                aperto = apri_snapshot(path, max_eta_s)
+                if aperto is not None:
+                    return aperto
+                built_at = time.time()
+                parti, completa = costruisci()
+                if not completa:
+                    logger.warning("Snapshot memoria NON scritto: caricamento globale incompleto")
+                    return parti, built_at
+                scrivi_snapshot(path, version, parti, built_at=built_at)
+                _pulisci_vecchi(path)
+                logger.info(f"📦 Snapshot memoria v{version} scritto: {os.path.basename(path)}")
+                return apri_snapshot(path) or (parti, built_at)
+            finally:
+                try:
+                    os.remove(lock)
+                except OSError:
+                    pass
+
+        # Lock di un altro processo: aspetto il file, o ne eredito il lock se e' orfano.
+        aperto = apri_snapshot(path, max_eta_s)
+        if aperto is not None:
+            return aperto
+        try:
+            if time.time() - os.path.getmtime(lock) > _LOCK_STALE_S:
+                logger.warning("Snapshot memoria: lock orfano rimosso")
+                os.remove(lock)
+                continue
+        except OSError:
+            continue  # lock sparito fra un controllo e l'altro: riprovo subito
+        if time.monotonic() >= scadenza:
+            logger.warning(f"Snapshot memoria v{version} non pronto dopo {attesa_s:.0f}s, caricamento per-processo")
+            return None
+        time.sleep(0.2)
@@ -0,0 +1,204 @@
+"""Estrazione del contenuto firmato da una busta P7M (CMS SignedData) in un passaggio.
+
+Problema: estrai_xml_da_p7m provava fino a sette strategie in cascata
+(asn1crypto, openssl in subprocess, ricerca pattern, scansione DER, pulizia
+byte, piu' i tentativi sul base64). Un file "difficile" le pagava tutte e, con
+la coda piena, ogni p7m che arrivava a openssl costava due fork (probe
+`openssl version` + `openssl cms`) e due file temporanei.
+
+Qui un lettore BER minimale percorre SOLO il cammino che porta al contenuto:
+
+    ContentInfo SEQUENCE
+      contentType OID = signedData (1.2.840.113549.1.7.2)
+      [0] EXPLICIT
+        SignedData SEQUENCE
+          version INTEGER, digestAlgorithms SET,
+          encapContentInfo SEQUENCE
+            eContentType OID
+            [0] EXPLICIT  OCTET STRING          (DER, lunghezza definita)
+                       |  OCTET STRING costruito (BER, chunk 0x04 e 0x80 / 00 00)
+
+Lavora su un memoryview: le testate TLV si leggono in posto, i chunk
+dell'OCTET STRING sono fette senza copia e l'unica copia e' il join finale.
+I fratelli a lunghezza indefinita vengono scorsi solo se serve superarli, quindi
+certificati e firme (dopo il contenuto) non si leggono mai.
+
+Gestisce anche le buste annidate (p7m firmato due volte: il contenuto e' a sua
+volta un ContentInfo) e il contenuto incapsulato come OCTET STRING DER (variante
+che asn1crypto trattava a parte). Non verifica la firma: come le strategie
+storiche, estrae e basta.
+"""
+
+from __future__ import annotations
+
+from typing import Iterator, List, Optional, Tuple
+
+# DER del contenuto degli OID (senza tag/lunghezza).
+_OID_SIGNED_DATA = bytes.fromhex('2a864886f70d010702')
+
+_SEQUENCE = 0x30
+_SET = 0x31
+_OID = 0x06
+_INTEGER = 0x02
+_OCTET = 0x04
+_OCTET_COSTRUITO = 0x24
+_CONTESTO_0 = 0xA0
+
+# Difese contro input malevoli/corrotti: annidamento e buste dentro buste.
+_PROFONDITA_MAX = 32
+_BUSTE_ANNIDATE_MAX = 3
+
+_Testata = Tuple[int, int, Optional[int]]  # (tag, inizio contenuto, fine | None se indefinita)
+
+
+class _BERNonValido(Exception):
+    pass
+
+
+def _testata(buf: memoryview, pos: int, limite: int) -> _Testata:
+    if pos + 2 > limite:
+        raise _BERNonValido("testata TLV troncata")
+    tag = buf[pos]
+    if tag & 0x1F == 0x1F:
+        raise _BERNonValido("tag multi-byte non previsto in CMS")
+    lb = buf[pos + 1]
+    pos += 2
+    if lb < 0x80:
+        n = lb
+    elif lb == 0x80:
+        if not tag & 0x20:
+            raise _BERNonValido("lunghezza indefinita su tipo primitivo")
+        return tag, pos, None
+    else:
+        k = lb & 0x7F
+        if k > 4 or pos + k > limite:
+            raise _BERNonValido("lunghezza non supportata")
+        n = int.from_bytes(buf[pos:pos + k], 'big')
+        pos += k
+    if pos + n > limite:
+        raise _BERNonValido("contenuto oltre la fine del buffer")
+    return tag, pos, pos + n
+
+
+def _fine_indefinita(buf: memoryview, inizio: int, limite: int, prof: int) -> int:
+    """Posizione subito dopo l'end-of-contents di un elemento a lunghezza indefinita."""
+    if prof > _PROFONDITA_MAX:
+        raise _BERNonValido("annidamento eccessivo")
+    pos = inizio
+    while True:
+        if pos + 2 > limite:
+            raise _BERNonValido("end-of-contents mancante")
+        if buf[pos] == 0 and buf[pos + 1] == 0:
+            return pos + 2
+        _tag, ini, fin = _testata(buf, pos, limite)
+        pos = fin if fin is not None else _fine_indefinita(buf, ini, limite, prof + 1)
+
+
+def _figli(buf: memoryview, inizio: int, fine: Optional[int], prof: int) -> Iterator[_Testata]:
+    """Testate dei figli di un elemento costruito. La fine di un figlio a
+    lunghezza indefinita si cerca solo se il chiamante chiede il successivo."""
+    if prof > _PROFONDITA_MAX:
+        raise _BERNonValido("annidamento eccessivo")
+    limite = len(buf) if fine is None else fine
+    pos = inizio
+    while pos < limite:
+        if fine is None and buf[pos] == 0 and pos + 1 < limite and buf[pos + 1] == 0:
+            return
+        figlio = _testata(buf, pos, limite)
+        yield figlio
+        _tag, ini, fin = figlio
+        pos = fin if fin is not None else _fine_indefinita(buf, ini, limite, prof + 1)
+
+
+def _primo(figli: Iterator[_Testata], tag_atteso: int) -> _Testata:
+    figlio = next(figli, None)
+    if figlio is None or figlio[0] != tag_atteso:
+        raise _BERNonValido(f"atteso tag 0x{tag_atteso:02x}")
+    return figlio
+
+
+def _raccogli_octet(buf: memoryview, testata: _Testata, out: List[memoryview], prof: int) -> int:
+    """Accoda le fette di un OCTET STRING (primitivo o a chunk) e ne ritorna la fine."""
+    if prof > _PROFONDITA_MAX:
+        raise _BERNonValido("annidamento eccessivo")
+    tag, ini, fin = testata
+    if tag == _OCTET:
+        out.append(buf[ini:fin])
+        return fin
+    if tag != _OCTET_COSTRUITO:
+        raise _BERNonValido("atteso OCTET STRING")
+    limite = len(buf) if fin is None else fin
+    pos = ini
+    while True:
+        if fin is None:
+            if pos + 2 > limite:
+                raise _BERNonValido("end-of-contents mancante")
+            if buf[pos] == 0 and buf[pos + 1] == 0:
+                return pos + 2
+        elif pos >= fin:
+            return fin
+        pos = _raccogli_octet(buf, _testata(buf, pos, limite), out, prof + 1)
+
+
+def _contenuto_incapsulato(buf: memoryview) -> Optional[bytes]:
+    tag, ini, fin = _testata(buf, 0, len(buf))
+    if tag != _SEQUENCE:
+        raise _BERNonValido("ContentInfo non e' una SEQUENCE")
+    content_info = _figli(buf, ini, fin, 1)
+    _t, oi, of = _primo(content_info, _OID)
+    if buf[oi:of] != _OID_SIGNED_DATA:
+        raise _BERNonValido("contentType diverso da signedData")
+    _t, ei, ef = _primo(content_info, _CONTESTO_0)
+    _t, si, sf = _primo(_figli(buf, ei, ef, 2), _SEQUENCE)
+    signed_data = _figli(buf, si, sf, 3)
+    _primo(signed_data, _INTEGER)
+    _primo(signed_data, _SET)
+    _t, ci, cf = _primo(signed_data, _SEQUENCE)
+    encap = _figli(buf, ci, cf, 4)
+    _primo(encap, _OID)
+    econtent = next(encap, None)
+    if econtent is None or econtent[0] != _CONTESTO_0:
+        return None  # firma detached: il contenuto non e' nella busta
+    _t, xi, xf = econtent
+    octet = next(_figli(buf, xi, xf, 5), None)
+    if octet is None:
+        return None
+    fette: List[memoryview] = []
+    _raccogli_octet(buf, octet, fette, 6)
+    return fette[0].tobytes() if len(fette) == 1 else b''.join(fette)
+
+
+def _octet_der(contenuto: bytes) -> Optional[bytes]:
+    """Contenuto che e' a sua volta un OCTET STRING codificato (doppio wrapping)."""
+    buf = memoryview(contenuto)
+    try:
+        testata = _testata(buf, 0, len(buf))
+        fette: List[memoryview] = []
+        if _raccogli_octet(buf, testata, fette, 0) != len(buf):
+            return None
+        return b''.join(fette)
+    except _BERNonValido:
+        return None
+
+
+def estrai_contenuto_p7m(contenuto_bytes: bytes) -> Optional[bytes]:
+    """Contenuto firmato di una busta CMS/PKCS#7 in DER o BER, o None.
+
+    Ritorna il contenuto solo se sembra testo markup (contiene '<'), come le
+    strategie storiche: il chiamante decide poi se e' una FatturaElettronica.
+    """
+    corrente = contenuto_bytes
+    for _ in range(_BUSTE_ANNIDATE_MAX):
+        try:
+            interno = _contenuto_incapsulato(memoryview(corrente))
+        except (_BERNonValido, IndexError):
+            return None
+        if not interno:
+            return None
+        if interno[:1] in (b'\x04', b'\x24'):
+            interno = _octet_der(interno) or interno
+        if interno[:1] == b'\x30':
+            corrente = interno  # busta annidata (firma multipla)
+            continue
+        return interno if b'<' in interno else None
+    return None
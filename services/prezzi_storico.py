@@ -0,0 +1,208 @@
+"""Storico prezzi per (ristorante, prodotto, fornitore): lettura, rebuild e coerenza.
+
+La tabella public.prezzi_storico ha una riga per coppia prodotto/fornitore
+della sede: ultimi acquisti (prezzo, data, quantita'), media, frequenza
+d'acquisto e categoria dell'ultimo acquisto. La mantiene il DB: trigger per
+statement su `fatture` ricalcolano solo le chiavi toccate da ogni scrittura
+(vedi migration 20260930100000_prezzi_storico.sql). Nessun chiamante Python
+deve aggiornarla: salvataggio fattura, soft delete, ripristino e cambio
+categoria la tengono allineata da soli, qualunque sia il percorso.
+
+Qui ci sono solo:
+- `leggi`: le righe della sede (opzionale: solo le coppie acquistate da una data);
+- `acquisti_recenti`: gli ultimi acquisti come righe nel formato di
+  carica_e_prepara_dataframe, da passare a db_service.calcola_alert;
+- `ricostruisci`: rebuild da zero via RPC (scripts/prezzi_storico.py);
+- `riepiloga` / `verifica_coerenza`: lo stesso riepilogo calcolato in Python
+  dalle righe grezze e il confronto con la tabella.
+"""
+
+from __future__ import annotations
+
+import math
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+import pandas as pd
+
+from config.logger_setup import get_logger
+from utils.supabase_paging import fetch_all
+
+logger = get_logger('prezzi_storico')
+
+TABELLA = "prezzi_storico"
+
+# Acquisti tenuti in ultimi_prezzi/ultime_date/ultime_quantita (allineato alla migration).
+N_ULTIMI = 12
+
+# Stesso regex di routers/prezzi._NC_TIPO_REGEX e del filtro nella migration.
+_NC_TIPO_REGEX = r"TD04|NOTA DI CREDITO|NOTA CREDITO|\bNC\b|CREDIT"
+
+_COLONNE = (
+    "descrizione_key,fornitore_key,descrizione,fornitore,categoria,n_acquisti,"
+    "prezzo_medio,quantita_media,prima_data,ultima_data,frequenza_mensile,"
+    "ultimi_prezzi,ultime_date,ultime_quantita,ultimo_file"
+)
+
+Chiave = Tuple[str, str]
+
+
+def _get_client(supabase_client):
+    if supabase_client is not None:
+        return supabase_client
+    from services import get_supabase_client
+    return get_supabase_client()
+
+
+def leggi(ristorante_id: str, supabase_client=None, *, dal: Optional[str] = None) -> List[Dict[str, Any]]:
+    """Righe di prezzi_storico della sede; con `dal` solo le coppie acquistate da quella data."""
+    q = (
+        _get_client(supabase_client).table(TABELLA)
+        .select(_COLONNE)
+        .eq("ristorante_id", ristorante_id)
+    )
+    if dal:
+        q = q.gte("ultima_data", dal)
+    return fetch_all(q.order("descrizione_key").order("fornitore_key"))
+
+
+def acquisti_recenti(righe: Iterable[Dict[str, Any]], *, dal: Optional[str] = None) -> pd.DataFrame:
+    """Ultimi acquisti di ogni coppia come righe fattura (colonne di carica_e_prepara_dataframe).
+
+    Descrizione e fornitore sono quelli prevalenti della coppia; FileOrigine e'
+    noto solo per l'ultimo acquisto. Con `dal` restano gli acquisti da quella data.
+    """
+    out: List[Dict[str, Any]] = []
+    for r in righe:
+        prezzi = r.get("ultimi_prezzi") or []
+        date = r.get("ultime_date") or []
+        quantita = r.get("ultime_quantita") or []
+        ultimo = len(prezzi) - 1
+        for i, (prezzo, data) in enumerate(zip(prezzi, date)):
+            if dal and (data is None or str(data) < dal):
+                continue
+            out.append({
+                "Descrizione": r.get("descrizione"),
+                "Fornitore": r.get("fornitore"),
+                "Categoria": r.get("categoria"),
+                "PrezzoUnitario": float(prezzo),
+                "Quantita": float(quantita[i]) if i < len(quantita) and quantita[i] is not None else None,
+                "DataDocumento": data,
+                "FileOrigine": (r.get("ultimo_file") or "") if i == ultimo else "",
+            })
+    colonne = ["Descrizione", "Fornitore", "Categoria", "PrezzoUnitario", "Quantita", "DataDocumento", "FileOrigine"]
+    return pd.DataFrame(out, columns=colonne)
+
+
+def ricostruisci(ristorante_id: Optional[str] = None, supabase_client=None) -> int:
+    """Ricalcola da zero lo storico di una sede (o di tutte con None); ritorna le righe scritte."""
+    resp = _get_client(supabase_client).rpc(
+        "prezzi_storico_ricostruisci", {"p_ristorante_id": ristorante_id}
+    ).execute()
+    n = int(resp.data or 0)
+    logger.info("prezzi_storico: ricostruite %d coppie (ristorante %s)", n, ristorante_id or "tutti")
+    return n
+
+
+def riepiloga(righe: Iterable[Dict[str, Any]]) -> Dict[Chiave, Dict[str, Any]]:
+    """Riepilogo atteso per coppia dalle righe grezze di `fatture` (stesse regole del trigger).
+
+    Le righe servono con descrizione, fornitore, prezzo_unitario, quantita,
+    data_documento, tipo_documento, categoria e id (ordine di arrivo a
+    parita' di data); quelle cancellate vanno gia' escluse.
+    """
+    df = pd.DataFrame(list(righe))
+    if df.empty:
+        return {}
+    df["prezzo_unitario"] = pd.to_numeric(df["prezzo_unitario"], errors="coerce")
+    df = df[df["prezzo_unitario"] > 0]
+    if "tipo_documento" in df.columns:
+        nc = df["tipo_documento"].fillna("").astype(str).str.upper().str.contains(_NC_TIPO_REGEX, regex=True)
+        df = df[~nc]
+    if df.empty:
+        return {}
+    df = df.assign(
+        _dk=df["descrizione"].fillna("").astype(str).str.strip().str.upper(),
+        _fk=df["fornitore"].fillna("").astype(str).str.strip().str.upper(),
+        _data=pd.to_datetime(df["data_documento"], errors="coerce"),
+    )
+    ordine = ["_dk", "_fk", "_data"] + (["id"] if "id" in df.columns else [])
+    df = df.sort_values(ordine, kind="mergesort")
+
+    out: Dict[Chiave, Dict[str, Any]] = {}
+    for (dk, fk), g in df.groupby(["_dk", "_fk"], sort=False):
+        coda = g.tail(N_ULTIMI)
+        date_valide = g["_data"].dropna()
+        if len(date_valide) >= 2:
+            arco = (date_valide.max() - date_valide.min()).days
+            frequenza = len(date_valide) / max(1.0, arco / 30.0)
+        else:
+            frequenza = 1.0
+        out[(dk, fk)] = {
+            "n_acquisti": len(g),
+            "prezzo_medio": float(g["prezzo_unitario"].mean()),
+            "frequenza_mensile": float(frequenza),
+            "ultima_data": date_valide.max().date().isoformat() if len(date_valide) else None,
+            "ultimi_prezzi": [float(p) for p in coda["prezzo_unitario"]],
+            "categoria": g["categoria"].iloc[-1] if "categoria" in g.columns else None,
+        }
+    return out
+
+
+def _diversi(a: Any, b: Any) -> bool:
+    if isinstance(a, list) or isinstance(b, list):
+        a, b = list(a or []), list(b or [])
+        return len(a) != len(b) or any(_diversi(x, y) for x, y in zip(a, b))
+    if isinstance(a, (int, float)) or isinstance(b, (int, float)):
+        try:
+            return not math.isclose(float(a), float(b), rel_tol=1e-6, abs_tol=1e-6)
+        except (TypeError, ValueError):
+            return True
+    return (str(a) if a is not None else None) != (str(b) if b is not None else None)
+
+
+def confronta(
+    attese: Dict[Chiave, Dict[str, Any]],
+    tabella: Iterable[Dict[str, Any]],
+    *,
+    max_esempi: int = 20,
+) -> Dict[str, Any]:
+    """Differenze tra il riepilogo atteso e le righe di prezzi_storico."""
+    presenti = {(str(r.get("descrizione_key")), str(r.get("fornitore_key"))): r for r in tabella}
+    mancanti = sorted(set(attese) - set(presenti))
+    in_eccesso = sorted(set(presenti) - set(attese))
+    diverse: List[Dict[str, Any]] = []
+    for k in sorted(set(attese) & set(presenti)):
+        campi = [c for c, v in attese[k].items() if _diversi(v, presenti[k].get(c))]
+        if campi:
+            diverse.append({"chiave": list(k), "campi": campi})
+    return {
+        "coerente": not (mancanti or in_eccesso or diverse),
+        "coppie_attese": len(attese),
+        "coppie_tabella": len(presenti),
+        "mancanti": [list(k) for k in mancanti[:max_esempi]],
+        "n_mancanti": len(mancanti),
+        "in_eccesso": [list(k) for k in in_eccesso[:max_esempi]],
+        "n_in_eccesso": len(in_eccesso),
+        "diverse": diverse[:max_esempi],
+        "n_diverse": len(diverse),
+    }
+
+
+def verifica_coerenza(ristorante_id: str, supabase_client=None) -> Dict[str, Any]:
+    """Ricalcola lo storico della sede dalle righe grezze e lo confronta con la tabella."""
+    sb = _get_client(supabase_client)
+    righe = fetch_all(
+        sb.table("fatture")
+        .select("id,descrizione,fornitore,prezzo_unitario,quantita,data_documento,tipo_documento,categoria")
+        .eq("ristorante_id", ristorante_id)
+        .is_("deleted_at", "null")
+        .gt("prezzo_unitario", 0)
+        .order("id")
+    )
+    esito = confronta(riepiloga(righe), leggi(ristorante_id, sb))
+    if not esito["coerente"]:
+        logger.warning(
+            "prezzi_storico incoerente per %s: %d mancanti, %d in eccesso, %d diverse",
+            ristorante_id, esito["n_mancanti"], esito["n_in_eccesso"], esito["n_diverse"],
+        )
+    return esito
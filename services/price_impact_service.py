@@ -11,13 +11,17 @@ Logica decisa da Mattia (doc Punto 1 §2):
 Questo service e' PURO/orchestratore: riusa calcola_alert (gia' food&beverage +
 impatto € pronti) e tag_analytics (gia' trend prezzi del tag). Nessuna dipendenza
 da Streamlit. Il backend calcola, la Home racconta.
+
+In modalita' "solo preferiti" i prodotti si leggono da prezzi_storico (una riga
+per coppia prodotto/fornitore, mantenuta dal DB); le righe fatture si caricano
+solo per Pareto e tag, o se lo storico non e' leggibile.
 """
 
 from __future__ import annotations
 
 import os
 from datetime import date, timedelta
-from typing import Any, Dict, List, Optional
+from typing import Any, Callable, Dict, List, Optional, Union
 
 import pandas as pd
 
@@ -180,7 +184,7 @@ def _alert_prodotti(
 def _alert_tag(
     user_id: str,
     ristorante_id: str,
-    df_completo: pd.DataFrame,
+    df_completo: Union[pd.DataFrame, Callable[[], pd.DataFrame]],
     soglia_perc_cliente: float,
 ) -> List[Dict[str, Any]]:
     """Aumenti sui custom TAG del cliente — il SUO focus, quindi prioritari.
@@ -199,6 +203,8 @@ def _alert_tag(
     che filtra lui per le sue finestre: cosi' il DataFrame si carica UNA volta
     sola per tutti i tag, invece di una ricarica completa da Supabase per ognuna
     delle 2×N chiamate (era il collo di bottiglia ~17s del briefing Home).
+    Puo' essere anche una funzione senza argomenti: si chiama solo se il
+    cliente ha dei tag, cosi' senza tag le righe non si caricano affatto.
     """
     try:
         tags = get_custom_tags(user_id, ristorante_id) or []
@@ -207,6 +213,10 @@ def _alert_tag(
         return []
     if not tags:
         return []
+    if callable(df_completo):
+        df_completo = df_completo()
+    if df_completo is None or df_completo.empty:
+        return []
 
     from services.tag_analytics_service import analizza_tag
 
@@ -270,6 +280,34 @@ def _alert_tag(
     return out
 
 
+def _acquisti_preferiti_da_storico(
+    ristorante_id: str,
+    preferiti_keys: set,
+    supabase_client=None,
+) -> Optional[pd.DataFrame]:
+    """Acquisti della finestra dei soli prodotti preferiti, letti da prezzi_storico.
+
+    Una riga per coppia (prodotto, fornitore) invece delle righe fattura del
+    periodo. calcola_alert guarda solo gli ultimi acquisti (ultimi 5 prezzi,
+    ultime 3 quantita', intervalli tra gli ultimi 4), che lo storico conserva:
+    ricostruiti come righe del df, il risultato e' quello delle righe grezze.
+    None se lo storico non e' leggibile: il chiamante ricade sul df.
+    """
+    from services import prezzi_storico
+
+    dal = (date.today() - timedelta(days=_FINESTRA_GIORNI)).isoformat()
+    try:
+        righe = prezzi_storico.leggi(ristorante_id, supabase_client, dal=dal)
+    except Exception as exc:
+        logger.warning("price_impact: lettura prezzi_storico fallita, uso le righe fatture: %s", exc)
+        return None
+    preferite = [
+        r for r in righe
+        if _pref_match_key(r.get("descrizione_key") or "", r.get("fornitore_key") or "") in preferiti_keys
+    ]
+    return prezzi_storico.acquisti_recenti(preferite, dal=dal)
+
+
 def _leggi_soglia_perc_cliente(user_id: str, supabase_client=None) -> float:
     """Soglia % alert prezzi salvata dal cliente (users.price_alert_threshold).
 
@@ -358,31 +396,31 @@ def calcola_alert_prezzi_impatto(
           "top": {...} | None,          # l'alert col maggior impatto
         }
     """
-    vuoto = {"count": 0, "alerts": [], "top": None}
-
-    try:
-        # force_refresh=False: la Home apre questo motore ad ogni caricamento; con
-        # force_refresh=True si ricaricavano e rielaboravano TUTTE le righe ogni
-        # volta (25s su clienti con migliaia di fatture -> timeout briefing). La
-        # cache 120s e' adeguata: gli alert prezzi non richiedono freschezza al secondo.
-        # Carica SOLO la finestra che il motore usa davvero (prodotti + tag lavorano
-        # entro _FINESTRA_GIORNI). Margine extra per i confronti ai bordi delle
-        # sotto-finestre di analizza_tag. Evita il full-load di tutta la storia
-        # (migliaia di righe -> 5s+ su clienti grossi, sforava il budget briefing).
-        df = carica_e_prepara_dataframe(
-            user_id, ristorante_id=ristorante_id,
-            supabase_client=supabase_client, force_refresh=False,
-            solo_ultimi_giorni=_FINESTRA_GIORNI + 10,
-        )
-    except Exception as exc:
-        logger.warning("price_impact: caricamento fatture fallito: %s", exc)
-        return vuoto
-    if df is None or df.empty:
-        return vuoto
-
-    df_periodo = _filtra_finestra(df, _FINESTRA_GIORNI)
-    if df_periodo.empty:
-        return vuoto
+    caricato: Dict[str, pd.DataFrame] = {}
+
+    def _df_finestra() -> pd.DataFrame:
+        # Righe fatture della finestra, caricate al piu' una volta e solo se
+        # servono (Pareto, tag, o storico prezzi non disponibile).
+        if "df" not in caricato:
+            try:
+                # force_refresh=False: la Home apre questo motore ad ogni caricamento; con
+                # force_refresh=True si ricaricavano e rielaboravano TUTTE le righe ogni
+                # volta (25s su clienti con migliaia di fatture -> timeout briefing). La
+                # cache 120s e' adeguata: gli alert prezzi non richiedono freschezza al secondo.
+                # Carica SOLO la finestra che il motore usa davvero (prodotti + tag lavorano
+                # entro _FINESTRA_GIORNI). Margine extra per i confronti ai bordi delle
+                # sotto-finestre di analizza_tag. Evita il full-load di tutta la storia
+                # (migliaia di righe -> 5s+ su clienti grossi, sforava il budget briefing).
+                df = carica_e_prepara_dataframe(
+                    user_id, ristorante_id=ristorante_id,
+                    supabase_client=supabase_client, force_refresh=False,
+                    solo_ultimi_giorni=_FINESTRA_GIORNI + 10,
+                )
+            except Exception as exc:
+                logger.warning("price_impact: caricamento fatture fallito: %s", exc)
+                df = None
+            caricato["df"] = df if df is not None else pd.DataFrame()
+        return caricato["df"]
 
     # Soglia % scelta dal cliente in pagina Prezzi (price_alert_threshold). E' il
     # "di quanto deve aumentare un prezzo perche' mi interessi" deciso da lui:
@@ -393,16 +431,24 @@ def calcola_alert_prezzi_impatto(
     # configuratore) oppure Pareto automatico (default AI-first). In modalita'
     # preferiti, se non ce ne sono, _alert_prodotti restituisce vuoto e restano
     # solo i tag (decisione Mattia: niente fallback al Pareto).
+    prodotti: List[Dict[str, Any]]
     if _leggi_solo_preferiti(ristorante_id, supabase_client):
         preferiti_keys = _carica_preferiti_keys(ristorante_id, supabase_client)
-        prodotti = _alert_prodotti(df_periodo, soglia_perc, set(), preferiti_keys=preferiti_keys)
+        if not preferiti_keys:
+            prodotti = []
+        else:
+            df_storico = _acquisti_preferiti_da_storico(ristorante_id, preferiti_keys, supabase_client)
+            if df_storico is None:
+                df_storico = _filtra_finestra(_df_finestra(), _FINESTRA_GIORNI)
+            prodotti = _alert_prodotti(df_storico, soglia_perc, set(), preferiti_keys=preferiti_keys)
     else:
         # Fascia Pareto dei prodotti che pesano davvero sulla spesa food: i
         # marginali (limoni & co.) restano fuori anche se rincarano molto.
+        df_periodo = _filtra_finestra(_df_finestra(), _FINESTRA_GIORNI)
         prodotti_pareto = _prodotti_pareto(df_periodo)
         prodotti = _alert_prodotti(df_periodo, soglia_perc, prodotti_pareto)
 
-    tag = _alert_tag(user_id, ristorante_id, df, soglia_perc)
+    tag = _alert_tag(user_id, ristorante_id, _df_finestra, soglia_perc)
 
     # Unisci e ordina per impatto €/mese decrescente; tieni i top.
     tutti = sorted(prodotti + tag, key=lambda a: a["impatto_mese"], reverse=True)
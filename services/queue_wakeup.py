@@ -0,0 +1,150 @@
+"""Sveglia del queue-worker: notifica "c'e' lavoro in coda" invece del polling puro.
+
+Problema: worker/run.py, a coda vuota, dorme WORKER_POLL_INTERVAL_SECONDS (15s)
+fra un claim e l'altro. E' il pavimento della latenza di ingest (una fattura
+appena arrivata aspetta in media 7-8s prima di essere toccata) e costa una RPC
+di claim ogni 15s anche quando non arriva niente.
+
+Soluzione: il queue-worker espone un endpoint HTTP minimale (stdlib, nessuna
+dipendenza) su WORKER_WAKEUP_PORT; chi accoda lavoro lo "sveglia" con una POST:
+
+    POST /sveglia/fatture   → nuovo record claimabile in fatture_queue
+    POST /sveglia/email     → nuovo record in ricavi_email_queue
+
+Chi sveglia: le Edge Function invoicetronic-webhook e ricavi-email-webhook dopo
+l'INSERT, e gli endpoint FastAPI che rimettono record in 'pending' (assegnazione
+sede, riprova admin). Il loop del worker blocca su `CanaleSveglia.attendi()` e
+usa il polling solo come rete di sicurezza (sveglia persa, mittente vecchio).
+
+Perche' non LISTEN/NOTIFY: il worker parla con Supabase solo via PostgREST
+(service_role su HTTPS), non ha una connessione Postgres diretta su cui
+restare in ascolto.
+
+Sicurezza: la POST richiede X-Worker-Key = WORKER_SECRET_KEY (confronto a tempo
+costante). Senza chiave il server non parte: meglio il polling che un endpoint
+aperto. La sveglia e' solo un suggerimento (il claim resta la fonte di verita'):
+una POST falsa costerebbe al massimo un claim a vuoto.
+
+Attivazione:
+    queue-worker:  WORKER_WAKEUP_PORT=8081  (assente = solo polling, come prima)
+    mittenti:      QUEUE_WORKER_WAKEUP_URL=http://queue-worker.railway.internal:8081
+"""
+
+from __future__ import annotations
+
+import os
+import secrets
+import threading
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Optional
+
+from config.logger_setup import get_logger
+
+logger = get_logger('queue_wakeup')
+
+CODA_FATTURE = "fatture"
+CODA_EMAIL = "email"
+CODE = (CODA_FATTURE, CODA_EMAIL)
+
+_TIMEOUT_SVEGLIA_S = 1.0
+
+
+class CanaleSveglia:
+    """Insieme di code "da guardare", condiviso fra il server HTTP e il loop.
+
+    `sveglia(coda)` puo' arrivare da qualunque thread; `attendi(timeout)` blocca
+    finche' arriva almeno una sveglia (o scade il timeout) e ritorna le code
+    svegliate, azzerandole. Sveglie multiple prima di attendi() si fondono in
+    una sola: il worker non deve contarle, deve solo sapere che c'e' lavoro.
+    """
+
+    def __init__(self) -> None:
+        self._cond = threading.Condition()
+        self._pendenti: set[str] = set()
+
+    def sveglia(self, coda: str) -> None:
+        with self._cond:
+            self._pendenti.add(coda)
+            self._cond.notify_all()
+
+    def attendi(self, timeout: float) -> set[str]:
+        """Ritorna le code svegliate; insieme vuoto = timeout (giro di polling)."""
+        with self._cond:
+            self._cond.wait_for(lambda: bool(self._pendenti), timeout=max(0.0, timeout))
+            svegliate, self._pendenti = self._pendenti, set()
+            return svegliate
+
+
+class _ServerSveglia(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, indirizzo, canale: CanaleSveglia, chiave: str) -> None:
+        super().__init__(indirizzo, _HandlerSveglia)
+        self.canale = canale
+        self.chiave = chiave
+
+
+class _HandlerSveglia(BaseHTTPRequestHandler):
+    server: _ServerSveglia
+
+    def do_POST(self) -> None:  # noqa: N802 - nome imposto da BaseHTTPRequestHandler
+        if not secrets.compare_digest(self.headers.get("X-Worker-Key") or "", self.server.chiave):
+            self.send_response(401)
+            self.end_headers()
+            return
+        parti = self.path.strip("/").split("/")
+        if len(parti) != 2 or parti[0] != "sveglia" or parti[1] not in CODE:
+            self.send_response(404)
+            self.end_headers()
+            return
+        self.server.canale.sveglia(parti[1])
+        self.send_response(204)
+        self.end_headers()
+
+    def log_message(self, format, *args) -> None:  # noqa: A002
+        # Una riga per sveglia nei log del worker sarebbe rumore: bastano i cicli.
+        pass
+
+
+def avvia_server_sveglia(
+    canale: CanaleSveglia,
+    porta: int,
+    chiave: str,
+    host: str = "0.0.0.0",
+) -> ThreadingHTTPServer:
+    """Avvia il server di sveglia in un thread daemon e lo ritorna (`server_address`
+    riporta la porta effettiva: con porta=0 ne sceglie una libera, utile nei test)."""
+    if not chiave:
+        raise ValueError("WORKER_SECRET_KEY mancante: server di sveglia non avviato")
+    server = _ServerSveglia((host, porta), canale, chiave)
+    threading.Thread(target=server.serve_forever, name="queue-wakeup", daemon=True).start()
+    logger.info("🔔 Sveglia coda in ascolto su %s:%d", host, server.server_address[1])
+    return server
+
+
+def sveglia_queue_worker(coda: str, url: Optional[str] = None, chiave: Optional[str] = None) -> bool:
+    """Sveglia il queue-worker (best-effort, timeout 1s). Ritorna True se la POST
+    e' andata a buon fine. Senza QUEUE_WORKER_WAKEUP_URL non fa nulla: il worker
+    trovera' comunque il lavoro al prossimo giro di polling."""
+    base = (url if url is not None else os.getenv("QUEUE_WORKER_WAKEUP_URL", "")).strip().rstrip("/")
+    if not base or coda not in CODE:
+        return False
+    key = chiave if chiave is not None else os.getenv("WORKER_SECRET_KEY", "")
+    req = urllib.request.Request(
+        f"{base}/sveglia/{coda}", data=b"", method="POST", headers={"X-Worker-Key": key},
+    )
+    try:
+        with urllib.request.urlopen(req, timeout=_TIMEOUT_SVEGLIA_S) as resp:
+            return 200 <= resp.status < 300
+    except Exception as exc:
+        logger.debug("Sveglia queue-worker (%s) non riuscita: %s", coda, exc)
+        return False
+
+
+def sveglia_queue_worker_async(coda: str) -> None:
+    """Come sveglia_queue_worker ma in un thread daemon: gli endpoint non devono
+    aspettare il worker (ne' il timeout se e' giu')."""
+    if not os.getenv("QUEUE_WORKER_WAKEUP_URL", "").strip():
+        return
+    threading.Thread(target=sveglia_queue_worker, args=(coda,), name="queue-wakeup-client", daemon=True).start()
@@ -419,6 +419,11 @@ def account_elimina(
         except Exception as exc:
             logger.warning("elimina-account: %s: %s", tabella, exc)
 
+    # Revoca PRIMA della delete: la cascata cancella le righe di `sessioni`, e
+    # sincronizza_revoche (session_token) non vedrebbe mai una revoca. I token di
+    # accesso gia' firmati resterebbero validi fino al loro TTL dopo l'eliminazione.
+    from services.session_service import revoca_tutte_sessioni
+    revoca_tutte_sessioni(user_id, sb)
     sb.table("users").delete().eq("id", user_id).execute()
     logger.warning("ELIMINA_ACCOUNT_SELF: email=%s | id=%s | extra=%s", email, user_id, deleted_extra)
     return {"ok": True, "messaggio": "Account e dati eliminati in modo permanente."}
@@ -513,6 +518,10 @@ def account_cambia_sede(
         raise HTTPException(status_code=404, detail="Sede non trovata per questo account")
 
     sb.table("users").update({"ultimo_ristorante_id": rid}).eq("id", user_id).execute()
+    # I token di accesso firmati portano la sede: quelli gia' emessi non valgono
+    # piu' (subito qui, negli altri processi alla sync delle revoche).
+    from services.session_service import invalida_token_accesso_utente
+    invalida_token_accesso_utente(user_id, supabase_client=sb)
 
     # Invalida la cache di sessione (TTL 30s, keyed sul token): senza questo
     # /api/auth/me e tutti gli endpoint che risolvono la sede attiva
@@ -43,12 +43,13 @@ logger = logging.getLogger("fastapi_worker")
 
 from utils.ttl_cache import TTLCache
 from utils.supabase_paging import fetch_all
+from services.queue_wakeup import sveglia_queue_worker_async
 
 # Cache in-process per gli endpoint Admin pesanti (overview, badge...). Sono dati
 # di monitoraggio che l'admin guarda: un TTL breve e' accettabile e li toglie dal
 # percorso caldo, cosi' un refresh admin non rifa' ogni volta le query aggregate
 # mentre i clienti usano l'app. Per-processo (vedi utils/ttl_cache.py).
-_ADMIN_CACHE = TTLCache(ttl=45.0)
+_ADMIN_CACHE = TTLCache(ttl=45.0, nome="admin", max_entries=64)
 
 
 def _fw():
@@ -1048,7 +1049,7 @@ class SuggerisciAiBody(BaseModel):
 
 
 def prepara_suggerimenti_ai(sb, allowed_ids: list, only_ids: Optional[list] = None,
-                            attore: str = "admin") -> dict:
+                            attore: str = "admin", modalita: str = "sincrona") -> dict:
     """Prepara suggerimenti AI per le righe dubbie SENZA scriverne la categoria.
 
     Per ogni descrizione 'da_verificare' che NON ha gia' un suggerimento
@@ -1058,6 +1059,10 @@ def prepara_suggerimenti_ai(sb, allowed_ids: list, only_ids: Optional[list] = No
 
     Idempotente: salta descrizioni con un suggerimento gia' fresco (<24h).
     Condivisa fra l'endpoint on-demand (A3) e l'agent notturno (B2).
+
+    modalita="batch" (agent notturno): invece delle chiamate GPT sincrone le
+    descrizioni diventano un job JSONL (services/ai_batch_notturno) applicato
+    in bulk con checkpoint, fuori dalla quota che serve agli upload.
     """
     import pandas as pd
     from datetime import datetime, timezone, timedelta
@@ -1158,6 +1163,12 @@ def prepara_suggerimenti_ai(sb, allowed_ids: list, only_ids: Optional[list] = No
     descs = [d for d, _ in pendenti]
     forns = [f for _, f in pendenti]
 
+    if modalita == "batch":
+        from services.ai_batch_notturno import esegui_job
+
+        res = esegui_job(sb, descs, forns, attore=attore)
+        return {"suggerite": res["suggerite"], "saltate": saltate, "errori": res["errori"]}
+
     suggerite = 0
     errori = 0
     now = datetime.now(timezone.utc).isoformat()
@@ -1779,6 +1790,22 @@ def admin_sistema_salute_worker():
     della Home si avvicina alla soglia lenti (4s) / al timeout SSR (12s), è il
     momento di potenziare Railway. Dati per-processo, finestra scorrevole in-memory
     (nessun costo, nessun servizio esterno). Si azzerano al riavvio del worker.
+
+    `p7m`: quale strategia ha aperto le buste firmate (lettore DER o ripieghi),
+    con tempo medio, e i fornitori le cui buste hanno richiesto un ripiego.
+
+    `ai_quota`: contatori giornalieri delle quote AI per ristorante in questo
+    processo (lotto prenotato, concesse/rifiutate, ripieghi sul COUNT).
+
+    `session_token`: revoche dei token di accesso firmati note al processo e
+    sincronizzazioni con `sessioni` (riuscite/fallite).
+
+    `cache`: le cache in-process del processo (utils/ttl_cache), le piu'
+    pesanti prima: voci, byte stimati contro il tetto, hit ratio, evictions.
+    Se l'RSS cresce, qui si vede quale cache lo sta occupando.
+
+    `cache_bus`: eventi di invalidazione pubblicati e ricevuti dagli altri
+    processi (web e queue-worker), pendenti ed errori verso `cache_eventi`.
     """
     from services import worker_metrics
     return worker_metrics.snapshot()
@@ -2350,6 +2377,8 @@ def admin_queue_assegna_piva(body: AssegnaPivaBody, admin_user: dict = Depends(_
 
     logger.warning("admin_queue_assegna_piva: piva=%s ristorante=%s record=%s | admin=%s",
                    piva, body.ristorante_id, n, admin_user.get("email"))
+    if n:
+        sveglia_queue_worker_async("fatture")
     return {"ok": True, "sbloccate": n}
 
 
@@ -2375,6 +2404,7 @@ def admin_queue_riprova(body: RiprovaQueueBody, admin_user: dict = Depends(_veri
     }).eq("id", body.queue_id).execute()
     logger.warning("admin_queue_riprova: queue_id=%s (era %s) | admin=%s",
                    body.queue_id, stato, admin_user.get("email"))
+    sveglia_queue_worker_async("fatture")
     return {"ok": True}
 
 
@@ -2399,6 +2429,7 @@ def admin_queue_assegna_sede(body: AssegnaSedeQueueBody, admin_user: dict = Depe
         return {"ok": False, "motivo": "gia_assegnata"}
     logger.warning("admin_queue_assegna_sede: queue_id=%s sede=%s | admin=%s",
                    body.queue_id, body.ristorante_id, admin_user.get("email"))
+    sveglia_queue_worker_async("fatture")
     return {"ok": True}
 
 
@@ -2673,6 +2704,11 @@ def admin_elimina_cliente(
     # prodotti_master (memoria AI globale) NON ha user_id: è condivisa fra tutti
     # i clienti e non è dato personale del singolo (stessa policy documentata in
     # account.py per l'auto-cancellazione). Non va toccata qui.
+    # Sessioni revocate PRIMA della delete, come in account.py: la cascata su
+    # `sessioni` cancellerebbe le righe senza che sincronizza_revoche le veda,
+    # lasciando validi fino al TTL i token di accesso gia' firmati del cliente.
+    from services.session_service import revoca_tutte_sessioni
+    revoca_tutte_sessioni(cliente_id, sb)
     sb.table("users").delete().eq("id", cliente_id).execute()
     logger.warning("ELIMINAZIONE_ACCOUNT: cliente=%s | admin=%s | deleted=%s", email_target, admin_user.get("email"), deleted)
     return {"ok": True, "deleted": deleted}
@@ -3024,6 +3060,10 @@ def admin_aggiorna_flags(
 
     if update:
         sb.table("users").update(update).eq("id", cliente_id).execute()
+        if "pagine_abilitate" in update or "attivo" in update:
+            # Pagine e stato account viaggiano nei token di accesso firmati.
+            from services.session_service import invalida_token_accesso_utente
+            invalida_token_accesso_utente(cliente_id, supabase_client=sb)
 
     if body.chat_ai_enabled is not None:
         ristorante_id = _get_ristorante_id_for_user(cliente_id, sb)
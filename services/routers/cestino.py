@@ -36,6 +36,10 @@ def _resolve_ristorante_id(*args, **kwargs):
     return _fw()._resolve_ristorante_id(*args, **kwargs)
 
 
+def _invalidate_fatture_rows_cache(*args, **kwargs):
+    return _fw()._invalidate_fatture_rows_cache(*args, **kwargs)
+
+
 def _verify_worker_key(x_worker_key: Optional[str] = Header(None)) -> None:
     return _fw()._verify_worker_key(x_worker_key)
 
@@ -113,6 +117,8 @@ def ripristina_dal_cestino(
         status = 404 if "not_found" in str(err) else 500
         raise HTTPException(status_code=status, detail=err)
 
+    # Le righe tornano visibili: cache righe Fatture/Prezzi di tutti i processi.
+    _invalidate_fatture_rows_cache(ristorante_id)
     return result
 
 
@@ -234,6 +240,7 @@ def elimina_fattura_soft(
         # l'invalidazione va ripetuta qui: senza, la lista fatture e il cestino
         # restano fermi fino al TTL (60-120s) dopo lo spostamento nel cestino.
         clear_fatture_cache()
+        _invalidate_fatture_rows_cache(ristorante_id)
 
         return {"success": True, "righe_eliminate": righe}
 
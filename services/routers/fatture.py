@@ -15,7 +15,8 @@ from pydantic import BaseModel
 
 from config.constants import TUTTE_LE_CATEGORIE
 # utils/ non importa services/: import diretto, nessun rischio di ciclo.
-from utils.supabase_paging import fetch_all
+from utils.supabase_paging import fetch_all, fetch_all_keyset_async
+from services.queue_wakeup import sveglia_queue_worker_async
 
 # Import LAZY da fastapi_worker per evitare il ciclo router<->fastapi_worker
 # (fastapi_worker importa questo router in coda al file). I simboli condivisi sono
@@ -46,6 +47,18 @@ def _resolve_ristorante_id(*args, **kwargs):
     return _fw()._resolve_ristorante_id(*args, **kwargs)
 
 
+async def _resolve_user_from_token_async(*args, **kwargs):
+    return await _fw()._resolve_user_from_token_async(*args, **kwargs)
+
+
+def _get_async_supabase_client(*args, **kwargs):
+    return _fw()._get_async_supabase_client(*args, **kwargs)
+
+
+async def _resolve_ristorante_id_async(*args, **kwargs):
+    return await _fw()._resolve_ristorante_id_async(*args, **kwargs)
+
+
 def _load_num_documento_map(*args, **kwargs):
     return _fw()._load_num_documento_map(*args, **kwargs)
 
@@ -236,24 +249,27 @@ def _compute_periodo_precedente(data_da: Optional[str], data_a: Optional[str]) -
 # ─── Endpoint: lista mesi disponibili ──────────────────────────────────────
 
 @router.get("/api/fatture/mesi-disponibili", response_model=MesiDisponibiliResponse, dependencies=[Depends(_verify_worker_key)])
-def get_mesi_disponibili(
+async def get_mesi_disponibili(
     authorization: Optional[str] = Header(None),
 ) -> MesiDisponibiliResponse:
-    user = _resolve_user_from_token(authorization)
-    ristorante_id = _resolve_ristorante_id(user, _get_supabase_client())
+    # Async (client PostgREST async): lo chiama ogni apertura di Analisi Fatture.
+    user = await _resolve_user_from_token_async(authorization)
+    supabase_client = _get_async_supabase_client()
+    ristorante_id = await _resolve_ristorante_id_async(user, supabase_client)
     if not ristorante_id:
         raise HTTPException(status_code=400, detail="Nessun ristorante associato")
 
-    supabase_client = _get_supabase_client()
     # Costruisce l'elenco dei mesi selezionabili: se tronca, al cliente
     # spariscono mesi dal filtro senza alcun errore visibile.
-    rows = fetch_all(
+    # Keyset su id: l'offset senza order() non garantisce pagine disgiunte.
+    q = (
         supabase_client.table("fatture_documenti")
-        .select("data_documento")
+        .select("id,data_documento")
         .eq("ristorante_id", ristorante_id)
         .is_("deleted_at", "null")
         .not_.is_("data_documento", "null")
     )
+    rows = await fetch_all_keyset_async(lambda: q)
     counts: Dict[str, int] = {}
     for r in rows:
         d = r.get("data_documento")
@@ -712,34 +728,22 @@ def get_fatture_trend(
 # ─── Endpoint: fornitori distinti del ristorante ───────────────────────────
 
 @router.get("/api/fatture/fornitori", dependencies=[Depends(_verify_worker_key)])
-def get_fornitori_disponibili(
+async def get_fornitori_disponibili(
     authorization: Optional[str] = Header(None),
 ) -> Dict[str, Any]:
-    user = _resolve_user_from_token(authorization)
-    supabase_client = _get_supabase_client()
-    ristorante_id = _resolve_ristorante_id(user, supabase_client)
+    user = await _resolve_user_from_token_async(authorization)
+    supabase_client = _get_async_supabase_client()
+    ristorante_id = await _resolve_ristorante_id_async(user, supabase_client)
     if not ristorante_id:
         raise HTTPException(status_code=400, detail="Nessun ristorante associato")
 
-    rows: List[Dict[str, Any]] = []
-    page_size = 1000
-    offset = 0
-    while True:
-        res = (
-            supabase_client.table("fatture")
-            .select("fornitore")
-            .eq("ristorante_id", ristorante_id)
-            .is_("deleted_at", "null")
-            .range(offset, offset + page_size - 1)
-            .execute()
-        )
-        batch = res.data or []
-        rows.extend(batch)
-        if len(batch) < page_size:
-            break
-        offset += page_size
-        if offset >= 50000:
-            break
+    q = (
+        supabase_client.table("fatture")
+        .select("id,fornitore")
+        .eq("ristorante_id", ristorante_id)
+        .is_("deleted_at", "null")
+    )
+    rows = await fetch_all_keyset_async(lambda: q)
     fornitori = sorted({(r.get("fornitore") or "").strip() for r in rows if r.get("fornitore")}, key=lambda s: s.casefold())
     return {"fornitori": fornitori}
 
@@ -747,25 +751,26 @@ def get_fornitori_disponibili(
 # ─── Endpoint: categorie disponibili ───────────────────────────────────────
 
 @router.get("/api/fatture/categorie", dependencies=[Depends(_verify_worker_key)])
-def get_categorie_disponibili(
+async def get_categorie_disponibili(
     authorization: Optional[str] = Header(None),
 ) -> Dict[str, Any]:
-    user = _resolve_user_from_token(authorization)
-    ristorante_id = _resolve_ristorante_id(user, _get_supabase_client())
+    user = await _resolve_user_from_token_async(authorization)
+    supabase_client = _get_async_supabase_client()
+    ristorante_id = await _resolve_ristorante_id_async(user, supabase_client)
     if not ristorante_id:
         raise HTTPException(status_code=400, detail="Nessun ristorante associato")
 
-    supabase_client = _get_supabase_client()
     # Categorie usate dal ristorante.
     # PostgREST tronca a max_rows (1000) le select senza .range(): senza questa
     # paginazione il filtro perdeva le categorie presenti solo oltre la millesima
     # riga — tra cui "Da Classificare", che deve restare visibile (CLAUDE.md §1).
-    rows = fetch_all(
+    q = (
         supabase_client.table("fatture")
-        .select("categoria")
+        .select("id,categoria")
         .eq("ristorante_id", ristorante_id)
         .is_("deleted_at", "null")
     )
+    rows = await fetch_all_keyset_async(lambda: q)
     categorie_usate = sorted({
         r["categoria"] for r in rows
         if r.get("categoria") and r["categoria"] not in _categorie_note_worker()
@@ -773,7 +778,7 @@ def get_categorie_disponibili(
 
     # Categorie canoniche (lista master) — facciamo query semplice
     try:
-        res_master = supabase_client.table("categorie").select("nome").execute()
+        res_master = await supabase_client.table("categorie").select("nome").execute()
         canoniche = sorted({c["nome"] for c in (res_master.data or []) if c.get("nome") and "DICITURE" not in c["nome"].upper()})
     except Exception:
         canoniche = []
@@ -1182,6 +1187,7 @@ def fatture_assegna_sede(
     if not assegnata:
         # Race: assegnata da un altro click nel frattempo. Non è un errore per la UI.
         return {"ok": False, "motivo": "gia_assegnata"}
+    sveglia_queue_worker_async("fatture")
     return {"ok": True, "queue_id": body.queue_id, "ristorante_id": rid}
 
 
@@ -15,14 +15,17 @@ risolti al primo uso, niente module-level __getattr__ (PEP 562 non risolve i
 lookup di nome globale interni → NameError → HTTP 500). _verify_worker_key resta
 esplicito perché usato in Depends() a import-time.
 """
-from typing import Any, Dict, List, Optional
+import os
+from typing import Any, Callable, Dict, List, Optional
 
 from fastapi import APIRouter, Depends, Header, HTTPException
 from pydantic import BaseModel
 
 from config.logger_setup import get_logger
 # utils/ non importa services/: import diretto, nessun rischio di ciclo.
+from utils.fan_out import in_parallelo
 from utils.supabase_paging import fetch_all
+from utils.ttl_cache import TTLCache
 
 logger = get_logger("router_gruppo")
 
@@ -59,6 +62,40 @@ def _chat_domande_oggi(*args, **kwargs):
 router = APIRouter()
 
 
+# Snapshot delle viste di catena (overview, spesa-pivot, margini-coperti,
+# spreco-categorie): la risposta assemblata, per account e parametri. La chiave
+# contiene la VERSIONE DATI delle sedi del gruppo (_versione_dati_sedi del
+# worker), che sale a ogni scrittura che invalida KPI o righe fatture di una
+# sede, anche in un altro processo (cache_bus): dopo un upload o un salvataggio
+# la vista si ricalcola subito, non allo scadere del TTL. Il TTL resta la rete
+# per cio' che non passa da quelle invalidazioni (coda fatture di gruppo,
+# segnali del giorno nel briefing): corto di proposito.
+_GRUPPO_SNAPSHOT_TTL = float(os.getenv("GRUPPO_SNAPSHOT_TTL_SEC", "120"))
+_GRUPPO_SNAPSHOT_CACHE = TTLCache(ttl=_GRUPPO_SNAPSHOT_TTL, nome="gruppo_snapshot", max_entries=500)
+
+
+def _snapshot_gruppo(
+    vista: str,
+    user_id: str,
+    nome_gruppo: str,
+    rid_to_nome: Dict[str, str],
+    ids: List[str],
+    parametri: tuple,
+    calcola: Callable[[], Any],
+) -> Any:
+    """Risposta di una vista di catena dallo snapshot, o calcolata una volta sola.
+
+    Single-flight (TTLCache.get_or_set): N tab aperte sulla stessa catena fanno
+    un solo calcolo. Nomi sede e giorno nella chiave: un rename o il cambio di
+    data (briefing "ieri", mese corrente) non servono uno snapshot vecchio.
+    """
+    chiave = (
+        vista, user_id, nome_gruppo, tuple((rid, rid_to_nome.get(rid)) for rid in ids),
+        parametri, _oggi().isoformat(), _fw()._versione_dati_sedi(ids),
+    )
+    return _GRUPPO_SNAPSHOT_CACHE.get_or_set(chiave, calcola)
+
+
 # ═══════════════════════════════════════════════════════════════════════════
 # OVERVIEW — KPI gruppo + salute media + ranking per margine%
 # ═══════════════════════════════════════════════════════════════════════════
@@ -137,18 +174,23 @@ class GruppoOverviewResponse(BaseModel):
     ranking: List[RankingPV]
 
 
-def _overrides_mese_sede(sb, ristorante_id: str, anno: int) -> Dict[int, Dict[str, float]]:
-    """Override ricavi 'modalità mensile' di UNA sede per l'anno, riindicizzati {mese: {...}}.
+def _overrides_mese_sedi(sb, ids: List[str], anno: int) -> Dict[str, Dict[int, Dict[str, float]]]:
+    """Override ricavi 'modalità mensile' delle sedi per l'anno, {rid: {mese: {...}}}.
 
-    Riusa _load_mensile_overrides del worker (stessa fonte del PV: ricavi_modalita_mensile)
-    così catena e pagina Margini leggono gli stessi ricavi. Best-effort: se la lettura
-    fallisce si torna {} e i ricavi ricadono sullo snapshot (comportamento storico).
+    Stessa fonte del PV (ricavi_modalita_mensile, via _load_mensile_overrides_sedi
+    del worker) così catena e pagina Margini leggono gli stessi ricavi, ma in UNA
+    query per tutte le sedi invece di una per sede. Best-effort: se la lettura
+    fallisce ogni sede ha {} e i ricavi ricadono sullo snapshot (comportamento
+    storico).
     """
     try:
-        raw = _fw()._load_mensile_overrides(sb, ristorante_id, [int(anno)])
+        raw = _fw()._load_mensile_overrides_sedi(sb, ids, [int(anno)])
     except Exception:
-        return {}
-    return {int(m): v for (a, m), v in (raw or {}).items() if int(a) == int(anno)}
+        raw = {}
+    return {
+        rid: {int(m): v for (a, m), v in ((raw or {}).get(rid) or {}).items() if int(a) == int(anno)}
+        for rid in ids
+    }
 
 
 def _aggrega_sedi_mensili(
@@ -590,16 +632,21 @@ def _periodo_anno_corrente() -> tuple[int, str]:
     return oggi.year, f"Anno {oggi.year}"
 
 
-def _anno_mese_corrente() -> tuple[int, int]:
-    """(anno, mese) correnti in fuso Europe/Rome. Serve a NON sommare i mesi
-    futuri: margini_mensili può contenere righe di mesi non ancora trascorsi
-    (proiezioni/seed di test) che gonfierebbero i totali anno-su-anno."""
+def _oggi():
+    """Data di oggi in fuso Europe/Rome."""
     from datetime import datetime as _dt
     try:
         from zoneinfo import ZoneInfo
-        oggi = _dt.now(tz=ZoneInfo("Europe/Rome")).date()
+        return _dt.now(tz=ZoneInfo("Europe/Rome")).date()
     except Exception:
-        oggi = _dt.now().date()
+        return _dt.now().date()
+
+
+def _anno_mese_corrente() -> tuple[int, int]:
+    """(anno, mese) correnti in fuso Europe/Rome. Serve a NON sommare i mesi
+    futuri: margini_mensili può contenere righe di mesi non ancora trascorsi
+    (proiezioni/seed di test) che gonfierebbero i totali anno-su-anno."""
+    oggi = _oggi()
     return oggi.year, oggi.month
 
 
@@ -727,7 +774,13 @@ def _periodo_da_query(data_da: Optional[str], data_a: Optional[str]) -> tuple[st
 )
 def gruppo_overview(authorization: Optional[str] = Header(None)) -> GruppoOverviewResponse:
     sb, user_id, sedi, nome_gruppo, rid_to_nome, ids = _resolve_gruppo(authorization)
+    return _snapshot_gruppo(
+        "overview", user_id, nome_gruppo, rid_to_nome, ids, _anno_mese_corrente(),
+        lambda: _gruppo_overview_calcola(sb, user_id, sedi, nome_gruppo, rid_to_nome, ids),
+    )
 
+
+def _gruppo_overview_calcola(sb, user_id, sedi, nome_gruppo, rid_to_nome, ids) -> GruppoOverviewResponse:
     anno, mese_corr = _anno_mese_corrente()
     periodo_label = f"Anno {anno}"
 
@@ -758,10 +811,9 @@ def gruppo_overview(authorization: Optional[str] = Header(None)) -> GruppoOvervi
     from services.margine_service import calcola_costi_automatici_gruppo_sql
     costi_auto_gruppo = calcola_costi_automatici_gruppo_sql(user_id, ids, anno)
 
-    # Ricavi in modalità mensile: vincono sullo snapshot, come sul PV. Per sede,
-    # perché ogni PV ha la sua modalità (una lettura per sede su una tabella piccola,
-    # 1 riga per mese: niente loop sulle righe fattura).
-    overrides_gruppo = {rid: _overrides_mese_sede(sb, rid, anno) for rid in ids}
+    # Ricavi in modalità mensile: vincono sullo snapshot, come sul PV. Ogni PV ha
+    # la sua modalità, ma si leggono tutte le sedi in una query.
+    overrides_gruppo = _overrides_mese_sedi(sb, ids, anno)
 
     mesi_periodo = list(range(1, mese_corr + 1))
     agg = _aggrega_sedi_mensili(
@@ -956,6 +1008,15 @@ def gruppo_spesa_pivot(
 
     sb, user_id, sedi, nome_gruppo, rid_to_nome, ids = _resolve_gruppo(authorization)
     da, a, periodo_label = _periodo_da_query(data_da, data_a)
+    return _snapshot_gruppo(
+        "spesa-pivot", user_id, nome_gruppo, rid_to_nome, ids, (dimensione, da, a),
+        lambda: _gruppo_spesa_pivot_calcola(sb, nome_gruppo, rid_to_nome, ids, dimensione, da, a, periodo_label),
+    )
+
+
+def _gruppo_spesa_pivot_calcola(
+    sb, nome_gruppo, rid_to_nome, ids, dimensione: str, da: str, a: str, periodo_label: str,
+) -> SpesaPivotResponse:
 
     # AGGREGAZIONE SQL (RPC gruppo_spesa_pivot): GROUP BY ristorante_id + dimensione.
     # NIENTE full-load delle righe fattura (regola non negoziabile della catena).
@@ -984,8 +1045,10 @@ def gruppo_spesa_pivot(
     # senza questa aggiunta i costi comuni non comparirebbero in nessuna colonna né nel
     # grand_total. Le quote entrano DENTRO le colonne dei PV, come nel tab Calcolo, così
     # l'app usa un criterio solo. Costo contenuto: ~15 categorie × N PV, non un full-load.
-    for rid in ids:
-        for riga in _righe_quote_gruppo(sb, rid, da, a):
+    # La proiezione è per PV (non si batcha): le N letture vanno con un pool limitato.
+    quote_per_sede = in_parallelo(lambda rid: _righe_quote_gruppo(sb, rid, da, a), ids, nome="gruppo-quote")
+    for rid, quote in zip(ids, quote_per_sede):
+        for riga in quote:
             if float(riga.get("totale_riga") or 0) <= 0:
                 continue
             if dimensione == "fornitore":
@@ -1067,8 +1130,17 @@ def gruppo_margini_coperti(
     authorization: Optional[str] = Header(None),
 ) -> MarginiCopertiResponse:
     sb, user_id, sedi, nome_gruppo, rid_to_nome, ids = _resolve_gruppo(authorization)
-    anno, mese_corr = _anno_mese_corrente()
     mese_sel = mese if (mese and 1 <= mese <= 12) else None
+    return _snapshot_gruppo(
+        "margini-coperti", user_id, nome_gruppo, rid_to_nome, ids, (_anno_mese_corrente(), mese_sel),
+        lambda: _gruppo_margini_coperti_calcola(sb, user_id, nome_gruppo, rid_to_nome, ids, mese_sel),
+    )
+
+
+def _gruppo_margini_coperti_calcola(
+    sb, user_id, nome_gruppo, rid_to_nome, ids, mese_sel: Optional[int],
+) -> MarginiCopertiResponse:
+    anno, mese_corr = _anno_mese_corrente()
     periodo_label = (
         f"{_MESI_IT[mese_sel - 1].capitalize()} {anno}" if mese_sel else f"Anno {anno}"
     )
@@ -1097,7 +1169,7 @@ def gruppo_margini_coperti(
     costi_auto_gruppo = calcola_costi_automatici_gruppo_sql(user_id, ids, anno)
 
     # Ricavi/coperti in modalità mensile: stessa fonte del PV (vedi gruppo_overview).
-    overrides_gruppo = {rid: _overrides_mese_sede(sb, rid, anno) for rid in ids}
+    overrides_gruppo = _overrides_mese_sedi(sb, ids, anno)
 
     # Un PV è "incompleto" se gli mancano i dati base (fatturato/fatture costo/
     # personale): stesso criterio del briefing/overview. Senza, mostrerebbe 0% in
@@ -1211,8 +1283,17 @@ def gruppo_spreco_categorie(
     authorization: Optional[str] = Header(None),
 ) -> SprecoCategorieResponse:
     sb, user_id, sedi, nome_gruppo, rid_to_nome, ids = _resolve_gruppo(authorization)
-    anno, mese_corr = _anno_mese_corrente()
     mese_sel = mese if (mese and 1 <= mese <= 12) else None
+    return _snapshot_gruppo(
+        "spreco-categorie", user_id, nome_gruppo, rid_to_nome, ids, (_anno_mese_corrente(), mese_sel),
+        lambda: _gruppo_spreco_categorie_calcola(sb, nome_gruppo, rid_to_nome, ids, mese_sel),
+    )
+
+
+def _gruppo_spreco_categorie_calcola(
+    sb, nome_gruppo, rid_to_nome, ids, mese_sel: Optional[int],
+) -> SprecoCategorieResponse:
+    anno, mese_corr = _anno_mese_corrente()
     periodo_label = (
         f"{_MESI_IT[mese_sel - 1].capitalize()} {anno}" if mese_sel else f"Anno {anno}"
     )
@@ -1237,7 +1318,7 @@ def gruppo_spreco_categorie(
         incompleti_set = set()
 
     # Coperti per (rid, anno, mese): margini_mensili + override mensile (stessa
-    # fonte del PV). Una sola lettura per tutti i PV.
+    # fonte del PV). Una sola lettura per tutti i PV, per ciascuna delle due.
     mm_resp = (
         sb.table("margini_mensili")
         .select("ristorante_id,anno,mese,coperti")
@@ -1250,26 +1331,23 @@ def gruppo_spreco_categorie(
         if r.get("coperti") is None:
             continue
         cop_map[(str(r["ristorante_id"]), int(r["anno"]), int(r["mese"]))] = int(r["coperti"])
-    for rid in ids:
-        try:
-            ov = fw._load_mensile_overrides(sb, rid, [anno])
-        except Exception:
-            ov = {}
-        for (y, m), o in ov.items():
+    for rid, ov in _overrides_mese_sedi(sb, ids, anno).items():
+        for m, o in ov.items():
             if o.get("coperti") is not None:
-                cop_map[(rid, y, m)] = o["coperti"]
+                cop_map[(rid, anno, m)] = o["coperti"]
 
-    # Costo F&B per (anno, mese, categoria) per ogni PV. Riuso l'aggregatore del
-    # worker, una chiamata per PV (i PV sono pochi: niente N+1 di rilievo).
+    # Costo F&B per (anno, mese, categoria) per ogni PV: l'aggregatore del worker
+    # legge il cubo costi una volta per tutte le sedi (periodo a mesi interi).
     # acc[(categoria, rid)] = {"costo": Σ costo (mesi con costo), "cop": Σ coperti}
     acc: Dict[tuple, Dict[str, float]] = {}
     categorie_viste: set = set()
+    try:
+        cat_per_sede = fw._load_fatture_fb_per_categoria_e_mese_sedi(sb, ids, data_da, data_a)
+    except Exception as exc:
+        logger.warning("spreco-categorie: aggregazione fatture fallita: %s", exc)
+        cat_per_sede = {}
     for rid in ids:
-        try:
-            cat_map = fw._load_fatture_fb_per_categoria_e_mese(sb, rid, data_da, data_a)
-        except Exception as exc:
-            logger.warning("spreco-categorie: aggregazione fatture fallita (%s): %s", rid, exc)
-            cat_map = {}
+        cat_map = cat_per_sede.get(rid) or {}
         for (y, m, cat) in list(cat_map.keys()):
             if cat in _SPRECO_CAT_ESCLUSE:
                 continue
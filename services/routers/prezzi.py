@@ -3,6 +3,7 @@
 Estratto da fastapi_worker.py. _load_num_documento_map resta nel worker (usato
 anche dalla sezione FATTURE) ed e' importato da qui. Path/gate/response invariati.
 """
+import os
 from typing import List, Optional
 
 from fastapi import APIRouter, Depends, Header, HTTPException
@@ -10,7 +11,10 @@ from pydantic import BaseModel
 
 # utils/ non importa services/: import diretto, nessun rischio di ciclo.
 from utils.supabase_paging import fetch_all
+from utils.righe_colonnari import RigheColonnari
 from utils.ttl_cache import TTLCache
+# Motore vettoriale puro (pandas/NumPy), non importa fastapi_worker.
+from services import variazioni_prezzi
 
 # Import LAZY da fastapi_worker per evitare il ciclo router<->fastapi_worker
 # (fastapi_worker importa questo router in coda al file). I simboli condivisi sono
@@ -36,6 +40,18 @@ def _resolve_ristorante_id(*args, **kwargs):
     return _fw()._resolve_ristorante_id(*args, **kwargs)
 
 
+async def _resolve_user_from_token_async(*args, **kwargs):
+    return await _fw()._resolve_user_from_token_async(*args, **kwargs)
+
+
+def _get_async_supabase_client(*args, **kwargs):
+    return _fw()._get_async_supabase_client(*args, **kwargs)
+
+
+async def _resolve_ristorante_id_async(*args, **kwargs):
+    return await _fw()._resolve_ristorante_id_async(*args, **kwargs)
+
+
 def _load_num_documento_map(*args, **kwargs):
     return _fw()._load_num_documento_map(*args, **kwargs)
 
@@ -267,112 +283,110 @@ def _carica_preferiti_keys(sb, ristorante_id: str) -> set:
     }
 
 
-def _calcola_variazioni_prezzi_sync(rows: list, soglia: float, preferiti_keys: set | None = None) -> list:
-    import pandas as pd
+_TREND_SIMBOLI = {
+    variazioni_prezzi.TREND_SALITA_FORTE: "⬆⬆",
+    variazioni_prezzi.TREND_DISCESA_FORTE: "⬇⬇",
+    variazioni_prezzi.TREND_OSCILLANTE: "↕",
+    variazioni_prezzi.TREND_SALITA: "⬆",
+    variazioni_prezzi.TREND_DISCESA: "⬇",
+}
 
-    if not rows:
-        return []
 
-    preferiti_keys = preferiti_keys or set()
+_COLONNE_VARIAZIONI = (
+    "descrizione", "fornitore", "categoria", "prezzo_unitario", "quantita",
+    "data_documento", "file_origine",
+)
 
-    df = pd.DataFrame(rows)
+
+def _prepara_variazioni(rows: list) -> variazioni_prezzi.BaseVariazioni:
+    """Acquisti validi ordinati e riepilogo per (prodotto, fornitore): la parte
+    costosa del calcolo, indipendente da soglia e preferiti (cachabile)."""
+    import pandas as pd
+
+    df = pd.DataFrame(rows) if rows else pd.DataFrame(columns=list(_COLONNE_VARIAZIONI))
     df['prezzo_unitario'] = pd.to_numeric(df['prezzo_unitario'], errors='coerce').fillna(0.0)
     df['quantita'] = pd.to_numeric(df.get('quantita', pd.Series(dtype=float)), errors='coerce').fillna(1.0)
 
-    df = df[~df['categoria'].isin(_CATEGORIE_SPESE_PREZZI)].copy()
+    df = df[~df['categoria'].isin(_CATEGORIE_SPESE_PREZZI)]
     # Note di credito (TD04): il filtro prezzo_unitario > 0 sotto esclude la
     # maggior parte (importo tipicamente negativo), ma alcuni fornitori emettono
     # TD04 con importo positivo (valore assoluto) — quelle passerebbero come un
     # vero acquisto e comparirebbero nel confronto prezzi come "aumento/calo"
     # fasullo. Escludiamo esplicitamente per tipo_documento, non per segno.
-    df = df[~_mask_nota_credito(df)].copy()
-    df = df[df['prezzo_unitario'] > 0].copy()
-
-    if df.empty:
-        return []
-
-    df['_desc_key'] = df['descrizione'].astype(str).str.strip().str.upper()
-    df['_forn_key'] = df['fornitore'].astype(str).str.strip().str.upper()
-
-    alert_list = []
-
-    for (_dk, _fk), group in df.groupby(['_desc_key', '_forn_key']):
-        group = group.sort_values('data_documento')
-        acquisti = group[group['prezzo_unitario'] > 0].copy()
-
-        if len(acquisti) < 2:
-            continue
+    df = df[~_mask_nota_credito(df)]
+    df = df[df['prezzo_unitario'] > 0]
+    # Solo le colonne dell'output: il riepilogo resta in cache (_base_variazioni).
+    df = df[[c for c in _COLONNE_VARIAZIONI if c in df.columns]]
+
+    return variazioni_prezzi.prepara(
+        df, descrizione='descrizione', fornitore='fornitore',
+        data='data_documento', prezzo='prezzo_unitario', quantita='quantita',
+    )
 
-        ultimo = acquisti.iloc[-1]
-        penultimo = acquisti.iloc[-2]
-        prezzo_ult = float(ultimo['prezzo_unitario'])
-        prezzo_pen = float(penultimo['prezzo_unitario'])
-        delta = prezzo_ult - prezzo_pen
-        var_pct = (delta / prezzo_pen) * 100
 
-        if abs(var_pct) < soglia:
-            continue
+def _calcola_variazioni_prezzi_sync(
+    rows: list,
+    soglia: float,
+    preferiti_keys: set | None = None,
+    base: variazioni_prezzi.BaseVariazioni | None = None,
+) -> list:
+    """Variazioni ultimo vs penultimo prezzo per (prodotto, fornitore) oltre `soglia` %.
 
-        nota = ""
-        try:
-            d_pen = pd.to_datetime(penultimo['data_documento'], utc=True)
-            d_ult = pd.to_datetime(ultimo['data_documento'], utc=True)
-            if (d_ult - d_pen).days > 180:
-                nota = " ⚠️ >6m"
-        except Exception:
-            pass
-
-        storico = " → ".join(f"€{p:.2f}" for p in acquisti.tail(5)['prezzo_unitario'])
-        media = float(acquisti['prezzo_unitario'].mean())
-
-        prezzi_rec = pd.to_numeric(acquisti['prezzo_unitario'].tail(4), errors='coerce').dropna().tolist()
-        var_rec = [
-            prezzi_rec[i] - prezzi_rec[i - 1]
-            for i in range(1, len(prezzi_rec))
-            if abs(prezzi_rec[i] - prezzi_rec[i - 1]) > 0.0001
-        ]
-        if len(var_rec) >= 3 and all(v > 0 for v in var_rec[-3:]):
-            trend = "⬆⬆"
-        elif len(var_rec) >= 3 and all(v < 0 for v in var_rec[-3:]):
-            trend = "⬇⬇"
-        elif var_rec and any(v > 0 for v in var_rec) and any(v < 0 for v in var_rec):
-            trend = "↕"
-        elif delta > 0:
-            trend = "⬆"
-        elif delta < 0:
-            trend = "⬇"
-        else:
-            trend = "↕"
+    `base` (da _prepara_variazioni, anche cachata) evita di rielaborare `rows`:
+    variazioni e score fornitori dello stesso periodo condividono lo stesso
+    riepilogo (services/variazioni_prezzi).
+    """
+    if base is None:
+        if not rows:
+            return []
+        base = _prepara_variazioni(rows)
 
-        desc_piena = str(group['descrizione'].mode()[0])
-        forn_piena = str(group['fornitore'].mode()[0])
-        pref_key = f"{_pulisci_desc_key(desc_piena)}|{_pulisci_forn_key(forn_piena)}"
-        is_preferito = pref_key in preferiti_keys
+    preferiti_keys = preferiti_keys or set()
+    sel = variazioni_prezzi.selezione(base, soglia)
+    if sel.empty:
+        return []
 
-        qta_all = pd.to_numeric(acquisti['quantita'], errors='coerce').dropna()
-        qta_ref = float(qta_all.mean()) if not qta_all.empty else 1.0
+    acq = base.acquisti
+    gid = acq['_gid']
+    nel_sel = gid.isin(sel.index)
+    desc_piena = variazioni_prezzi.prevalenti(acq[nel_sel], 'descrizione', gid[nel_sel]).to_dict()
+    forn_piena = variazioni_prezzi.prevalenti(acq[nel_sel], 'fornitore', gid[nel_sel]).to_dict()
+    ultime = acq.iloc[sel['riga_ult'].to_numpy()]
 
-        date_all = pd.to_datetime(acquisti['data_documento'], errors='coerce').dropna().sort_values()
-        freq = 1.0
-        if len(date_all) >= 2:
-            n_mesi = max(1.0, (date_all.iloc[-1] - date_all.iloc[0]).days / 30.0)
-            freq = len(date_all) / n_mesi
+    def colonna(nome: str) -> list:
+        return ultime[nome].tolist() if nome in ultime.columns else [''] * len(sel)
 
+    alert_list = []
+    metriche = (
+        sel[c].tolist() for c in (
+            'stagionale', 'delta', 'media_tutti', 'prezzo_pen', 'prezzo_ult', 'var_pct',
+            'trend', 'qta_media_tutti', 'freq_periodo', 'storico',
+        )
+    )
+    for g, stag, delta, media, pen, ult, pct, trend, qta, freq, storico, cat, data, fo, d0, f0 in zip(
+        sel.index.tolist(), *metriche,
+        colonna('categoria'), colonna('data_documento'), colonna('file_origine'),
+        colonna('descrizione'), colonna('fornitore'),
+    ):
+        desc = str(desc_piena.get(g, d0))
+        forn = str(forn_piena.get(g, f0))
+        nota = " ⚠️ >6m" if stag else ""
+        delta = float(delta)
         alert_list.append({
-            'prodotto': (desc_piena + nota)[:60],
-            'categoria': str(ultimo.get('categoria', ''))[:25],
-            'fornitore': forn_piena[:30],
+            'prodotto': (desc + nota)[:60],
+            'categoria': str(cat)[:25],
+            'fornitore': forn[:30],
             'storico': storico,
-            'media': round(media, 4),
-            'penultimo': round(prezzo_pen, 4),
-            'ultimo': round(prezzo_ult, 4),
-            'aumento_perc': round(var_pct, 2),
-            'data': str(ultimo.get('data_documento', '')),
-            'n_fattura': str(ultimo.get('file_origine', '')),
-            'trend': trend,
-            'impatto_stimato': round(float(delta * qta_ref * freq), 2),
+            'media': round(float(media), 4),
+            'penultimo': round(float(pen), 4),
+            'ultimo': round(float(ult), 4),
+            'aumento_perc': round(float(pct), 2),
+            'data': str(data),
+            'n_fattura': str(fo),
+            'trend': _TREND_SIMBOLI[trend],
+            'impatto_stimato': round(delta * float(qta) * float(freq), 2),
             'delta_euro': round(delta, 4),
-            'preferito': is_preferito,
+            'preferito': f"{_pulisci_desc_key(desc)}|{_pulisci_forn_key(forn)}" in preferiti_keys,
         })
 
     alert_list.sort(key=lambda x: x['aumento_perc'], reverse=True)
@@ -383,17 +397,38 @@ def _calcola_variazioni_prezzi_sync(rows: list, soglia: float, preferiti_keys: s
 # storico) rifanno la STESSA scansione del periodo, e le tab del frontend sono
 # lazy: ogni tab aperta era un full-load da capo, ~4,3 s misurati sulla sede piu'
 # grande (2,45 MB in 10 round-trip; il tempo e' quasi tutto trasporto, non query).
-# Stesso TTL corto e stessa logica della cache righe di FATTURE
-# (_FATTURE_ROWS_TTL): abbatte le riletture dello stesso caricamento pagina senza
-# tenere dati stale dopo una modifica. Cache PER-PROCESSO: con
-# WORKER_WEB_CONCURRENCY>1 ogni worker ha la sua copia, accettabile per un'analisi
-# non critica al secondo.
-_PREZZI_ROWS_CACHE = TTLCache(ttl=15.0)
-
-
-def _invalidate_prezzi_rows_cache() -> None:
-    """Invalida la cache righe di Prezzi (chiamata insieme a quella di Fatture)."""
-    _PREZZI_ROWS_CACHE.invalidate()
+# Stesso TTL e stessa logica della cache righe di FATTURE (_FATTURE_ROWS_TTL):
+# abbatte le riletture delle tab senza tenere dati stale dopo una modifica.
+# Cache PER-PROCESSO, ma invalidata insieme a quella di FATTURE anche negli altri
+# processi (services/cache_bus). Le righe stanno in forma colonnare
+# (utils/righe_colonnari): ogni endpoint riceve dict nuovi, la cache tiene solo
+# gli array compressi.
+_PREZZI_ROWS_CACHE = TTLCache(
+    ttl=120.0, nome="prezzi_righe", max_entries=256,
+    max_bytes=int(float(os.getenv("WORKER_CACHE_RIGHE_MAX_MB", "256")) * 1024 * 1024),
+)
+
+
+# Riepilogo variazioni del periodo (services/variazioni_prezzi) derivato dalle
+# stesse righe: variazioni e score fornitori lo calcolano una volta e lo
+# riusano, soglia e preferiti si applicano dopo. Stessa chiave e stessa
+# invalidazione della cache righe.
+_PREZZI_VARIAZIONI_CACHE = TTLCache(
+    ttl=120.0, nome="prezzi_variazioni", max_entries=256,
+    max_bytes=int(float(os.getenv("WORKER_CACHE_RIGHE_MAX_MB", "256")) * 1024 * 1024),
+)
+
+
+def _invalidate_prezzi_rows_cache(ristorante_id: Optional[str] = None) -> None:
+    """Invalida la cache righe di Prezzi (tutto, o solo un ristorante).
+
+    Chiamata insieme a quella di Fatture (_invalidate_fatture_rows_cache).
+    """
+    for cache in (_PREZZI_ROWS_CACHE, _PREZZI_VARIAZIONI_CACHE):
+        if ristorante_id is None:
+            cache.invalidate()
+        else:
+            cache.invalidate_where(lambda k: k.startswith(f"{ristorante_id}::"))
 
 
 def _load_fatture_for_prezzi(
@@ -418,7 +453,16 @@ def _load_fatture_for_prezzi(
         )
 
     return _PREZZI_ROWS_CACHE.get_or_set(
-        f"{ristorante_id}::{data_da}::{data_a}::{cols}", _fetch
+        f"{ristorante_id}::{data_da}::{data_a}::{cols}",
+        lambda: RigheColonnari.da_righe(_fetch()),
+    ).righe()
+
+
+def _base_variazioni(sb, ristorante_id: str, data_da: str, data_a: str) -> variazioni_prezzi.BaseVariazioni:
+    """Riepilogo variazioni del periodo, condiviso da variazioni e score fornitori."""
+    return _PREZZI_VARIAZIONI_CACHE.get_or_set(
+        f"{ristorante_id}::{data_da}::{data_a}",
+        lambda: _prepara_variazioni(_load_fatture_for_prezzi(sb, ristorante_id, data_da, data_a)),
     )
 
 
@@ -439,12 +483,12 @@ def _load_nc_file_origini(sb, ristorante_id: str, data_da: str, data_a: str) ->
 
 
 @router.get("/api/prezzi/soglia-alert", tags=["Prezzi"], dependencies=[Depends(_verify_worker_key)])
-def get_soglia_alert(
+async def get_soglia_alert(
     authorization: Optional[str] = Header(None),
 ) -> SogliaAlertResponse:
-    user = _resolve_user_from_token(authorization)
-    sb = _get_supabase_client()
-    resp = sb.table("users").select("price_alert_threshold").eq("id", user["id"]).limit(1).execute()
+    user = await _resolve_user_from_token_async(authorization)
+    sb = _get_async_supabase_client()
+    resp = await sb.table("users").select("price_alert_threshold").eq("id", user["id"]).limit(1).execute()
     val = _PRICE_ALERT_DEFAULT
     if resp.data:
         raw = resp.data[0].get("price_alert_threshold")
@@ -485,9 +529,9 @@ def get_variazioni_prezzi(
     if not ristorante_id:
         raise HTTPException(status_code=400, detail="Nessun ristorante associato")
 
-    all_rows = _load_fatture_for_prezzi(sb, ristorante_id, data_da, data_a)
+    base = _base_variazioni(sb, ristorante_id, data_da, data_a)
     preferiti_keys = _carica_preferiti_keys(sb, ristorante_id)
-    variazioni = _calcola_variazioni_prezzi_sync(all_rows, soglia, preferiti_keys)
+    variazioni = _calcola_variazioni_prezzi_sync([], soglia, preferiti_keys, base=base)
 
     scostamento_medio = 0.0
     impatto_netto = 0.0
@@ -508,15 +552,15 @@ def get_variazioni_prezzi(
 
 
 @router.get("/api/prezzi/preferiti", tags=["Prezzi"], dependencies=[Depends(_verify_worker_key)])
-def get_preferiti(
+async def get_preferiti(
     authorization: Optional[str] = Header(None),
 ) -> PreferitiResponse:
-    user = _resolve_user_from_token(authorization)
-    sb = _get_supabase_client()
-    ristorante_id = _resolve_ristorante_id(user, sb)
+    user = await _resolve_user_from_token_async(authorization)
+    sb = _get_async_supabase_client()
+    ristorante_id = await _resolve_ristorante_id_async(user, sb)
     if not ristorante_id:
         raise HTTPException(status_code=400, detail="Nessun ristorante associato")
-    resp = (
+    resp = await (
         sb.table("prezzi_preferiti")
         .select("descrizione_key,fornitore_key")
         .eq("ristorante_id", ristorante_id)
@@ -1354,7 +1398,9 @@ def get_score_fornitori(
             fornitori=[], periodo="", n_fornitori_valutati=0, n_fornitori_insufficienti=0,
         )
 
-    variazioni = _calcola_variazioni_prezzi_sync(all_rows, soglia)
+    variazioni = _calcola_variazioni_prezzi_sync(
+        all_rows, soglia, base=_base_variazioni(sb, ristorante_id, data_da, data_a),
+    )
     nc_map = _nc_credito_per_fornitore(sb, ristorante_id, data_da, data_a, rows=all_rows)
     fornitori = _calcola_score_fornitori(all_rows, variazioni, nc_map)
 
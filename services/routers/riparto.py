@@ -20,6 +20,8 @@ from typing import Any, Dict, List, Optional
 from fastapi import APIRouter, Depends, Header, HTTPException
 from pydantic import BaseModel
 
+from services.queue_wakeup import sveglia_queue_worker_async
+
 import logging
 logger = logging.getLogger("fastapi_worker")
 
@@ -368,7 +370,9 @@ def riparto_da_coda(body: RipartoDaCodaBody, authorization: Optional[str] = Head
     # 3) Assegna alla sede tecnica → il worker processa la fattura in background.
     res = sb.rpc("assegna_fattura_a_sede_tecnica", {"p_queue_id": body.queue_id}).execute()
     sede_tecnica_id = res.data if res.data else None
-    if not sede_tecnica_id:
+    if sede_tecnica_id:
+        sveglia_queue_worker_async("fatture")
+    else:
         # Race: assegnata da un altro click. Il riparto resta valido (idempotente sul
         # file_origine); non è un errore per la UI.
         logger.warning("assegna_fattura_a_sede_tecnica no-op per queue_id=%s (race)", body.queue_id)
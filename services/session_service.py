@@ -10,10 +10,11 @@ Funzioni pubbliche:
 - risolvi_sessione(token) -> user_id | None    : valida (attiva + non scaduta per inattività)
 - tocca_sessione(token)                        : aggiorna last_seen_at (throttled)
 - revoca_sessione(token) -> bool               : revoca la singola sessione (logout/exit)
+- invalida_token_accesso_utente(user_id)       : scarta i token di accesso gia' emessi
+                                                 (services/session_token) senza sloggare
 """
 
 import secrets
-import time
 from datetime import datetime, timedelta, timezone
 from typing import Optional
 
@@ -23,11 +24,15 @@ from config.constants import (
     MAX_SESSIONI_ATTIVE,
 )
 from config.logger_setup import get_logger
+from utils.ttl_cache import TTLCache
 
 logger = get_logger('session')
 
-# Throttle in-process per le scritture di last_seen_at: {token: last_write_epoch}.
-_LAST_SEEN_THROTTLE: dict = {}
+# Throttle in-process per le scritture di last_seen_at: un token presente ha
+# scritto da meno di LAST_SEEN_WRITE_THROTTLE_SECONDS. Limitato: keyed per token.
+_LAST_SEEN_THROTTLE = TTLCache(
+    ttl=LAST_SEEN_WRITE_THROTTLE_SECONDS, nome="last_seen_throttle", max_entries=10000,
+)
 
 
 def _now_iso() -> str:
@@ -99,6 +104,13 @@ def risolvi_sessione(token: str, supabase_client=None) -> Optional[str]:
     Ritorna None anche se il token non esiste in `sessioni` (il chiamante applica
     il fallback legacy su users.session_token).
     """
+    row = sessione_attiva(token, supabase_client=supabase_client)
+    return str(row["user_id"]) if row else None
+
+
+def sessione_attiva(token: str, supabase_client=None) -> Optional[dict]:
+    """Come risolvi_sessione, ma ritorna la riga {id, user_id}: l'id è il `sid`
+    dei token di accesso firmati emessi per questa sessione."""
     if not token:
         return None
 
@@ -140,18 +152,16 @@ def risolvi_sessione(token: str, supabase_client=None) -> Optional[str]:
         logger.info("Sessione scaduta per inattività (>%sh) revocata: user=%s", SESSION_INACTIVITY_HOURS, row.get("user_id"))
         return None
 
-    return str(row["user_id"])
+    return {"id": str(row.get("id") or ""), "user_id": str(row["user_id"])}
 
 
 def tocca_sessione(token: str, supabase_client=None) -> None:
     """Aggiorna last_seen_at della sessione corrente, con throttle in-process."""
     if not token:
         return
-    now = time.time()
-    last = _LAST_SEEN_THROTTLE.get(token)
-    if last is not None and (now - last) < LAST_SEEN_WRITE_THROTTLE_SECONDS:
+    if _LAST_SEEN_THROTTLE.get(token) is not None:
         return
-    _LAST_SEEN_THROTTLE[token] = now
+    _LAST_SEEN_THROTTLE.set(token, True)
     try:
         sb = _client(supabase_client)
         sb.table("sessioni").update({"last_seen_at": _now_iso()}).eq("token", token).is_("revoked_at", "null").execute()
@@ -180,6 +190,7 @@ def revoca_tutte_sessioni(user_id: str, supabase_client=None, escludi_token: str
             q = q.neq("token", escludi_token)
         res = q.execute()
         _clear_sessione_cache_auth()
+        _revoca_token_accesso(res.data, user_id=None if escludi_token else str(user_id))
         return len(res.data or [])
     except Exception:
         logger.exception("Errore revoca tutte le sessioni")
@@ -199,8 +210,9 @@ def revoca_sessione(token: str, supabase_client=None) -> bool:
             .is_("revoked_at", "null")
             .execute()
         )
-        _LAST_SEEN_THROTTLE.pop(token, None)
+        _LAST_SEEN_THROTTLE.invalidate(token)
         _clear_sessione_cache_auth(token)
+        _revoca_token_accesso(res.data)
         return bool(res.data)
     except Exception:
         logger.exception("Errore revoca sessione")
@@ -217,3 +229,37 @@ def _clear_sessione_cache_auth(token: Optional[str] = None) -> None:
         _clear_sessione_cache(token)
     except Exception:
         logger.exception("Errore invalidazione cache sessione auth_service (non bloccante)")
+
+
+def invalida_token_accesso_utente(user_id: str, supabase_client=None) -> None:
+    """Scarta i token di accesso firmati già emessi per l'utente, senza revocare
+    le sessioni: il client ne chiede uno nuovo con i dati aggiornati (cambio
+    sede attiva, pagine abilitate). Subito in questo processo; negli altri alla
+    prossima sincronizzazione delle revoche (sessioni.access_non_prima_di)."""
+    if not user_id:
+        return
+    try:
+        from services.session_token import revoca_utente
+        revoca_utente(str(user_id))
+    except Exception:
+        logger.exception("Errore revoca locale token di accesso (non bloccante)")
+    try:
+        sb = _client(supabase_client)
+        sb.table("sessioni").update({"access_non_prima_di": _now_iso()}) \
+            .eq("user_id", str(user_id)).is_("revoked_at", "null").execute()
+    except Exception:
+        logger.exception("Errore invalidazione token di accesso a DB (non bloccante)")
+
+
+def _revoca_token_accesso(righe, user_id: Optional[str] = None) -> None:
+    """Registra subito, in questo processo, la revoca dei token di accesso delle
+    sessioni appena revocate (gli altri processi la leggono da revoked_at)."""
+    try:
+        from services.session_token import revoca_sid, revoca_utente
+        if user_id:
+            revoca_utente(user_id)
+        for r in righe if isinstance(righe, list) else []:
+            if isinstance(r, dict) and r.get("id"):
+                revoca_sid(str(r["id"]))
+    except Exception:
+        logger.exception("Errore revoca locale token di accesso (non bloccante)")
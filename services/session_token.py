@@ -0,0 +1,257 @@
+"""Token di accesso firmati (HMAC) a vita breve, verificati senza I/O.
+
+Problema: ogni richiesta autenticata passava da verifica_sessione_da_cookie.
+Con la cache fredda (TTL 30s, per processo) questo significava un lookup su
+`sessioni` e una SELECT su `users`, piu' un'altra SELECT su users per la sede
+attiva in _resolve_user_from_token. La Home apre 6-7 richieste in parallelo e
+con WORKER_WEB_CONCURRENCY=4 ogni processo scaldava la propria cache: l'auth
+stava sul percorso critico di tutte.
+
+Qui il worker emette, a partire da una sessione valida di `sessioni`, un token
+`ofa1.<payload>.<firma>`. Il payload contiene l'utente (id, email, pagine,
+tema, sede attiva), l'id della sessione (`sid`) e le date di emissione e
+scadenza (TTL breve, default 120s). Lo firma con HMAC-SHA256. La verifica e'
+locale: firma, scadenza e lista delle revoche.
+
+Revoche: `sid → non_prima_di` (epoch) in memoria. Un token emesso prima di
+`non_prima_di` non vale piu'. La lista si allinea al DB, al massimo ogni
+`ONEFLUX_REVOCHE_SYNC_S` secondi (default 5), leggendo da `sessioni` le
+righe con `revoked_at` o `access_non_prima_di` recenti. Un solo thread
+sincronizza, gli altri usano la lista corrente senza aspettare. Nel processo
+che revoca, logout e cambio sede registrano la revoca subito (`revoca_sid`,
+`revoca_utente`).
+
+Chiave: ONEFLUX_ACCESS_TOKEN_KEY, oppure una chiave derivata da
+WORKER_SECRET_KEY. Senza nessuna delle due l'emissione e' disattivata e si
+resta sul token di sessione (stessi endpoint, stesso comportamento di prima).
+"""
+
+from __future__ import annotations
+
+import base64
+import hashlib
+import hmac
+import json
+import os
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, Optional, Tuple
+
+from config.logger_setup import get_logger
+
+logger = get_logger('session_token')
+
+PREFISSO = "ofa1."
+
+# Campi utente copiati nel token: gli stessi che verifica_sessione_da_cookie
+# restituisce sul path `sessioni` (niente campi sensibili).
+CAMPI_UTENTE = (
+    "id", "email", "nome_ristorante", "nome_referente", "attivo",
+    "pagine_abilitate", "tema", "ultimo_ristorante_id", "privacy_accepted_at",
+)
+
+# Oltre, si dimenticano le revoche piu' vecchie: un token vive al massimo TTL
+# secondi, le revoche piu' vecchie del TTL non possono piu' colpire nessuno.
+_MAX_REVOCHE = 20000
+
+
+def ttl_secondi() -> int:
+    try:
+        return max(10, int(os.getenv("ONEFLUX_ACCESS_TOKEN_TTL_S", "120")))
+    except ValueError:
+        return 120
+
+
+def _intervallo_sync() -> float:
+    try:
+        return max(0.0, float(os.getenv("ONEFLUX_REVOCHE_SYNC_S", "5")))
+    except ValueError:
+        return 5.0
+
+
+def _chiave() -> Optional[bytes]:
+    esplicita = os.getenv("ONEFLUX_ACCESS_TOKEN_KEY", "")
+    if esplicita:
+        return esplicita.encode("utf-8")
+    worker = os.getenv("WORKER_SECRET_KEY", "")
+    if worker:
+        # Chiave dedicata derivata: la X-Worker-Key non firma mai direttamente.
+        return hmac.new(worker.encode("utf-8"), b"oneflux-access-token", hashlib.sha256).digest()
+    return None
+
+
+def abilitato() -> bool:
+    return _chiave() is not None
+
+
+def e_token_accesso(token: Optional[str]) -> bool:
+    return bool(token) and token.startswith(PREFISSO)
+
+
+def _b64(dati: bytes) -> str:
+    return base64.urlsafe_b64encode(dati).rstrip(b"=").decode("ascii")
+
+
+def _unb64(testo: str) -> bytes:
+    return base64.urlsafe_b64decode(testo + "=" * (-len(testo) % 4))
+
+
+def _firma(chiave: bytes, corpo: str) -> str:
+    return _b64(hmac.new(chiave, corpo.encode("ascii"), hashlib.sha256).digest())
+
+
+def emetti(user: Dict[str, Any], sid: str, ttl: Optional[int] = None) -> Optional[Tuple[str, int]]:
+    """(token, scadenza epoch) per l'utente della sessione `sid`; None se disattivato."""
+    chiave = _chiave()
+    if chiave is None or not user or not sid:
+        return None
+    ora = time.time()
+    scadenza = int(ora) + (ttl or ttl_secondi())
+    payload = {
+        "u": {k: user.get(k) for k in CAMPI_UTENTE},
+        "sid": str(sid),
+        # Arrotondato per difetto: mai "dopo" una revoca dello stesso istante.
+        "iat": int(ora * 1000) / 1000,
+        "exp": scadenza,
+    }
+    corpo = PREFISSO + _b64(json.dumps(payload, separators=(",", ":"), default=str).encode("utf-8"))
+    return f"{corpo}.{_firma(chiave, corpo)}", scadenza
+
+
+def verifica(token: str) -> Optional[Dict[str, Any]]:
+    """Dict utente se il token e' integro, non scaduto e non revocato; altrimenti None."""
+    chiave = _chiave()
+    if chiave is None or not e_token_accesso(token):
+        return None
+    corpo, sep, firma = token.rpartition(".")
+    if not sep or not hmac.compare_digest(firma, _firma(chiave, corpo)):
+        return None
+    try:
+        payload = json.loads(_unb64(corpo[len(PREFISSO):]))
+        utente = dict(payload["u"])
+        sid = str(payload["sid"])
+        emesso = float(payload["iat"])
+        scadenza = float(payload["exp"])
+    except (ValueError, KeyError, TypeError):
+        return None
+    if scadenza <= time.time():
+        return None
+    _sincronizza_se_serve()
+    if _revocato(sid, str(utente.get("id") or ""), emesso):
+        return None
+    return utente
+
+
+# ── Revoche ──────────────────────────────────────────────────────────────────
+
+_revoche_sid: Dict[str, float] = {}
+_revoche_utente: Dict[str, float] = {}
+_revoche_lock = threading.Lock()
+_sync_lock = threading.Lock()
+_sync_stato: Dict[str, Any] = {"ultimo": 0.0, "sincronizzazioni": 0, "errori": 0}
+
+
+def _registra(mappa: Dict[str, float], chiave: str, quando: float) -> None:
+    with _revoche_lock:
+        if quando > mappa.get(chiave, 0.0):
+            mappa.pop(chiave, None)
+            mappa[chiave] = quando
+        while len(mappa) > _MAX_REVOCHE:
+            mappa.pop(next(iter(mappa)))
+
+
+def revoca_sid(sid: str, quando: Optional[float] = None) -> None:
+    """Invalida subito, in questo processo, i token gia' emessi per la sessione."""
+    if sid:
+        _registra(_revoche_sid, str(sid), time.time() if quando is None else quando)
+
+
+def revoca_utente(user_id: str, quando: Optional[float] = None) -> None:
+    """Come revoca_sid, per tutte le sessioni dell'utente (cambio sede, flag admin)."""
+    if user_id:
+        _registra(_revoche_utente, str(user_id), time.time() if quando is None else quando)
+
+
+def _revocato(sid: str, user_id: str, emesso: float) -> bool:
+    with _revoche_lock:
+        soglia = max(_revoche_sid.get(sid, 0.0), _revoche_utente.get(user_id, 0.0))
+    return emesso < soglia
+
+
+def _epoch(valore: Any) -> Optional[float]:
+    if not valore:
+        return None
+    try:
+        dt = datetime.fromisoformat(str(valore).replace("Z", "+00:00"))
+    except ValueError:
+        return None
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+    return dt.timestamp()
+
+
+def _sincronizza_se_serve() -> None:
+    if time.monotonic() - _sync_stato["ultimo"] < _intervallo_sync():
+        return
+    # Non bloccante: se un altro thread sta gia' sincronizzando, si verifica
+    # con la lista corrente (al piu' un intervallo di ritardo).
+    if not _sync_lock.acquire(blocking=False):
+        return
+    try:
+        if time.monotonic() - _sync_stato["ultimo"] < _intervallo_sync():
+            return
+        sincronizza_revoche()
+    finally:
+        _sync_lock.release()
+
+
+def sincronizza_revoche(supabase_client=None) -> int:
+    """Allinea la lista revoche a `sessioni`; ritorna le righe lette (-1 su errore)."""
+    _sync_stato["ultimo"] = time.monotonic()
+    # Solo le revoche che possono ancora colpire un token vivo (+ margine).
+    # Formato con 'Z': un '+00:00' nel filtro .or_() finirebbe nella query string.
+    dal = (datetime.now(timezone.utc) - timedelta(seconds=ttl_secondi() + 60)).strftime("%Y-%m-%dT%H:%M:%SZ")
+    try:
+        if supabase_client is None:
+            from services import get_supabase_client
+            supabase_client = get_supabase_client()
+        resp = (
+            supabase_client.table("sessioni")
+            .select("id, revoked_at, access_non_prima_di")
+            .or_(f"revoked_at.gte.{dal},access_non_prima_di.gte.{dal}")
+            .execute()
+        )
+    except Exception as exc:
+        _sync_stato["errori"] += 1
+        logger.warning("Revoche token di accesso: sync fallita (%s)", exc)
+        return -1
+    righe = resp.data if isinstance(resp.data, list) else []
+    for r in righe:
+        if not isinstance(r, dict) or not r.get("id"):
+            continue
+        quando = max(_epoch(r.get("revoked_at")) or 0.0, _epoch(r.get("access_non_prima_di")) or 0.0)
+        if quando:
+            _registra(_revoche_sid, str(r["id"]), quando)
+    _sync_stato["sincronizzazioni"] += 1
+    return len(righe)
+
+
+def stato() -> Dict[str, Any]:
+    with _revoche_lock:
+        n_sid, n_utenti = len(_revoche_sid), len(_revoche_utente)
+    return {
+        "abilitato": abilitato(),
+        "ttl_s": ttl_secondi(),
+        "revoche_sessioni": n_sid,
+        "revoche_utenti": n_utenti,
+        "sincronizzazioni": _sync_stato["sincronizzazioni"],
+        "errori_sync": _sync_stato["errori"],
+    }
+
+
+def reset() -> None:
+    with _revoche_lock:
+        _revoche_sid.clear()
+        _revoche_utente.clear()
+    _sync_stato.update(ultimo=0.0, sincronizzazioni=0, errori=0)
@@ -0,0 +1,296 @@
+"""Client PostgREST asincrono per gli endpoint `async def` del worker FastAPI.
+
+Problema: gli endpoint sono `def` sincroni e FastAPI li esegue nel threadpool di
+AnyIO. Ogni richiesta tiene occupato un thread per TUTTO il round-trip verso
+Supabase (supabase-py e' sincrono): la Home spara 6-7 chiamate in parallelo per
+utente e, sotto carico, il limite di thread (alzato a 100 in `lifespan`) e' il
+primo a esaurirsi — le richieste restano in coda anche con CPU e DB liberi.
+
+Soluzione: un client httpx.AsyncClient condiviso per processo, con keep-alive e
+HTTP/2 (una connessione TLS multiplexata verso Supabase invece di una per
+thread), e un query builder con la STESSA forma a catena di supabase-py:
+
+    asb = get_async_client()
+    resp = await (
+        asb.table("fatture").select("categoria")
+           .eq("ristorante_id", rid).is_("deleted_at", "null")
+           .range(0, 999).execute()
+    )
+    resp.data  # list[dict]
+
+Cosi' portare un endpoint e' aggiungere `async`/`await`, non riscriverne le
+query. Per la paginazione c'e' `utils.supabase_paging.fetch_all_keyset_async`
+(scansioni complete) o `fetch_all_async` (ordine arbitrario).
+
+Differenze volute rispetto a supabase-py:
+  - il builder e' IMMUTABILE: ogni metodo ritorna una copia. `range()` non
+    accumula parametri (il difetto documentato in utils/supabase_paging) e lo
+    stesso builder base si puo' riusare per N pagine senza effetti collaterali;
+  - copre solo cio' che serve agli endpoint in lettura (select, filtri, order,
+    range, single, count, rpc). Le scritture restano sul client sincrono.
+
+Il client httpx e' legato all'event loop che lo crea: ne teniamo uno per loop
+(in produzione uno per processo uvicorn) e `chiudi_async_client()` lo chiude nel
+lifespan.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import os
+from typing import Any, Dict, List, Optional, Tuple
+
+import httpx
+
+from config.logger_setup import get_logger
+
+logger = get_logger('supabase_async')
+
+# Allineato a SyncClientOptions(postgrest_client_timeout=30) del client sincrono.
+_TIMEOUT_S = 30.0
+
+try:  # HTTP/2 richiede il pacchetto `h2` (gia' dipendenza transitiva di supabase)
+    import h2  # noqa: F401
+    _HTTP2 = True
+except ImportError:  # pragma: no cover - dipende dall'ambiente
+    _HTTP2 = False
+
+# Caratteri riservati nella grammatica dei filtri PostgREST: un valore che li
+# contiene, dentro una lista `in.(...)`, va racchiuso fra doppi apici.
+_RISERVATI = set(',.:()" \\')
+
+
+class PostgrestAsyncError(Exception):
+    """Errore PostgREST (HTTP >= 400), con gli stessi campi di postgrest.APIError."""
+
+    def __init__(self, status: int, payload: Any) -> None:
+        info = payload if isinstance(payload, dict) else {"message": str(payload)}
+        self.status = status
+        self.code = info.get("code")
+        self.message = info.get("message") or f"HTTP {status}"
+        self.details = info.get("details")
+        self.hint = info.get("hint")
+        super().__init__(f"{self.message} (HTTP {status}, code={self.code})")
+
+
+class RispostaAsync:
+    """Risultato di execute(): `data` come supabase-py, `count` se richiesto."""
+
+    __slots__ = ("data", "count")
+
+    def __init__(self, data: Any, count: Optional[int] = None) -> None:
+        self.data = data
+        self.count = count
+
+
+def _valore(v: Any) -> str:
+    if v is True:
+        return "true"
+    if v is False:
+        return "false"
+    if v is None:
+        return "null"
+    return str(v)
+
+
+def _voce_lista(v: Any) -> str:
+    s = _valore(v)
+    if any(c in _RISERVATI for c in s):
+        return '"' + s.replace("\\", "\\\\").replace('"', '\\"') + '"'
+    return s
+
+
+def _count_da_content_range(header: Optional[str]) -> Optional[int]:
+    # "0-999/6315" oppure "*/0"; "*" dopo la barra = count non richiesto.
+    if not header or "/" not in header:
+        return None
+    totale = header.rsplit("/", 1)[1]
+    return int(totale) if totale.isdigit() else None
+
+
+class QueryAsync:
+    """Query builder immutabile su una tabella/vista (forma a catena di supabase-py)."""
+
+    def __init__(
+        self,
+        client: "AsyncPostgrest",
+        tabella: str,
+        params: Tuple[Tuple[str, str], ...] = (),
+        headers: Tuple[Tuple[str, str], ...] = (),
+        nega: bool = False,
+    ) -> None:
+        self._client = client
+        self._tabella = tabella
+        self._params = params
+        self._headers = headers
+        self._nega = nega
+
+    def _con(self, params=(), headers=(), nega: bool = False) -> "QueryAsync":
+        return QueryAsync(self._client, self._tabella, self._params + tuple(params),
+                          self._headers + tuple(headers), nega)
+
+    def _senza(self, *nomi: str) -> Tuple[Tuple[str, str], ...]:
+        return tuple(p for p in self._params if p[0] not in nomi)
+
+    def _filtro(self, colonna: str, operatore: str, valore: str) -> "QueryAsync":
+        prefisso = "not." if self._nega else ""
+        return self._con(params=((colonna, f"{prefisso}{operatore}.{valore}"),))
+
+    # ── Proiezione ────────────────────────────────────────────────────────────
+    def select(self, colonne: str = "*", count: Optional[str] = None) -> "QueryAsync":
+        q = QueryAsync(self._client, self._tabella, self._senza("select"), self._headers)
+        q = q._con(params=(("select", "".join(colonne.split())),))
+        if count:
+            q = q._con(headers=(("Prefer", f"count={count}"),))
+        return q
+
+    # ── Filtri ────────────────────────────────────────────────────────────────
+    @property
+    def not_(self) -> "QueryAsync":
+        """Nega il filtro successivo: `.not_.is_("data", "null")` → `data=not.is.null`."""
+        return self._con(nega=True)
+
+    def eq(self, colonna: str, valore: Any) -> "QueryAsync":
+        return self._filtro(colonna, "eq", _valore(valore))
+
+    def neq(self, colonna: str, valore: Any) -> "QueryAsync":
+        return self._filtro(colonna, "neq", _valore(valore))
+
+    def gt(self, colonna: str, valore: Any) -> "QueryAsync":
+        return self._filtro(colonna, "gt", _valore(valore))
+
+    def gte(self, colonna: str, valore: Any) -> "QueryAsync":
+        return self._filtro(colonna, "gte", _valore(valore))
+
+    def lt(self, colonna: str, valore: Any) -> "QueryAsync":
+        return self._filtro(colonna, "lt", _valore(valore))
+
+    def lte(self, colonna: str, valore: Any) -> "QueryAsync":
+        return self._filtro(colonna, "lte", _valore(valore))
+
+    def like(self, colonna: str, pattern: str) -> "QueryAsync":
+        return self._filtro(colonna, "like", pattern)
+
+    def ilike(self, colonna: str, pattern: str) -> "QueryAsync":
+        return self._filtro(colonna, "ilike", pattern)
+
+    def is_(self, colonna: str, valore: Any) -> "QueryAsync":
+        return self._filtro(colonna, "is", _valore(valore))
+
+    def in_(self, colonna: str, valori) -> "QueryAsync":
+        return self._filtro(colonna, "in", "(" + ",".join(_voce_lista(v) for v in valori) + ")")
+
+    def or_(self, filtri: str) -> "QueryAsync":
+        return self._con(params=(("or", f"({filtri})"),))
+
+    # ── Ordinamento e finestra ────────────────────────────────────────────────
+    def order(self, colonna: str, desc: bool = False) -> "QueryAsync":
+        voce = f"{colonna}.{'desc' if desc else 'asc'}"
+        esistente = [v for k, v in self._params if k == "order"]
+        params = self._senza("order") + (("order", ",".join(esistente + [voce])),)
+        return QueryAsync(self._client, self._tabella, params, self._headers)
+
+    def limit(self, n: int) -> "QueryAsync":
+        return QueryAsync(self._client, self._tabella, self._senza("limit") + (("limit", str(int(n))),),
+                          self._headers)
+
+    def range(self, inizio: int, fine: int) -> "QueryAsync":
+        # Sostituisce (non accumula) offset/limit: vedi docstring del modulo.
+        params = self._senza("offset", "limit") + (
+            ("offset", str(int(inizio))), ("limit", str(int(fine) - int(inizio) + 1)),
+        )
+        return QueryAsync(self._client, self._tabella, params, self._headers)
+
+    def single(self) -> "QueryAsync":
+        return self._con(headers=(("Accept", "application/vnd.pgrst.object+json"),))
+
+    # ── Esecuzione ────────────────────────────────────────────────────────────
+    async def execute(self) -> RispostaAsync:
+        return await self._client._get(self._tabella, list(self._params), dict(self._headers))
+
+
+class AsyncPostgrest:
+    """Client PostgREST asincrono service-role, con pool di connessioni condiviso."""
+
+    def __init__(
+        self,
+        url: str,
+        key: str,
+        *,
+        timeout: float = _TIMEOUT_S,
+        max_connections: int = 50,
+        max_keepalive: int = 20,
+        transport: Optional[httpx.AsyncBaseTransport] = None,
+    ) -> None:
+        self.base_url = url.rstrip("/") + "/rest/v1"
+        self._http = httpx.AsyncClient(
+            base_url=self.base_url,
+            headers={"apikey": key, "Authorization": f"Bearer {key}"},
+            timeout=timeout,
+            http2=_HTTP2 and transport is None,
+            limits=httpx.Limits(max_connections=max_connections,
+                                max_keepalive_connections=max_keepalive),
+            transport=transport,
+        )
+
+    def table(self, nome: str) -> QueryAsync:
+        return QueryAsync(self, nome)
+
+    async def rpc(self, funzione: str, params: Optional[Dict[str, Any]] = None) -> RispostaAsync:
+        resp = await self._http.post(f"/rpc/{funzione}", json=params or {})
+        return self._risposta(resp)
+
+    async def _get(self, tabella: str, params: List[Tuple[str, str]], headers: Dict[str, str]) -> RispostaAsync:
+        resp = await self._http.get(f"/{tabella}", params=params, headers=headers)
+        return self._risposta(resp)
+
+    @staticmethod
+    def _risposta(resp: httpx.Response) -> RispostaAsync:
+        try:
+            payload = resp.json() if resp.content else None
+        except ValueError:
+            payload = resp.text
+        if resp.status_code >= 400:
+            raise PostgrestAsyncError(resp.status_code, payload)
+        return RispostaAsync(payload, _count_da_content_range(resp.headers.get("content-range")))
+
+    async def aclose(self) -> None:
+        await self._http.aclose()
+
+
+# Un client per event loop: httpx.AsyncClient non puo' attraversare loop diversi.
+_CLIENT_PER_LOOP: Dict[int, Tuple[asyncio.AbstractEventLoop, str, AsyncPostgrest]] = {}
+
+
+def get_async_client() -> AsyncPostgrest:
+    """Client async condiviso per (event loop corrente, SUPABASE_URL, chiave).
+
+    Solleva RuntimeError se Supabase non e' configurato o se chiamato fuori da
+    un event loop (il chiamante FastAPI lo converte in HTTP 500).
+    """
+    url = os.environ.get("SUPABASE_URL", "")
+    key = os.environ.get("SUPABASE_SERVICE_ROLE_KEY") or os.environ.get("SUPABASE_KEY", "")
+    if not url or not key:
+        raise RuntimeError("Supabase non configurato (SUPABASE_URL / SUPABASE_SERVICE_ROLE_KEY).")
+    loop = asyncio.get_running_loop()
+    firma = f"{url}::{key[:8]}"
+    voce = _CLIENT_PER_LOOP.get(id(loop))
+    if voce is not None and voce[0] is loop and voce[1] == firma:
+        return voce[2]
+    # Loop chiusi (test, reload) lasciano voci morte: le togliamo qui.
+    for k in [k for k, v in _CLIENT_PER_LOOP.items() if v[0].is_closed()]:
+        _CLIENT_PER_LOOP.pop(k, None)
+    client = AsyncPostgrest(
+        url, key,
+        max_connections=int(os.environ.get("SUPABASE_ASYNC_MAX_CONNECTIONS", "50")),
+    )
+    _CLIENT_PER_LOOP[id(loop)] = (loop, firma, client)
+    logger.info("Client PostgREST async creato (http2=%s)", _HTTP2)
+    return client
+
+
+async def chiudi_async_client() -> None:
+    """Chiude il client del loop corrente (shutdown del lifespan)."""
+    voce = _CLIENT_PER_LOOP.pop(id(asyncio.get_running_loop()), None)
+    if voce is not None:
+        await voce[2].aclose()
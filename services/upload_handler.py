@@ -34,6 +34,7 @@ from services.ai_service import (
     _applica_guardrail_note_con_importo,
     AIDailyLimitExceededError,
 )
+from services.gpt_dispatcher import dimensiona_batch, esegui_in_parallelo
 
 
 def _categoria_affidabile(descrizione: str, categoria: str, confidence: str, fornitore: str) -> bool:
@@ -621,29 +622,17 @@ def _run_post_upload_ai_categorization(supabase_client, user_id: str, file_names
                 remaining_reasons[reason] += 1
                 remaining_descs.append(desc)
 
-        chunk_size = 30
-
-        for start in range(0, len(descs_for_ai), chunk_size):
-            chunk = descs_for_ai[start:start + chunk_size]
-            ai_memory_upserts = []
-            chunk_update_groups: dict[tuple[str, bool], list[int]] = {}
-            fornitori = [desc_map[d]['fornitore'] for d in chunk]
-            iva = [desc_map[d]['iva'] for d in chunk]
-            hint = [ottieni_hint_per_ai(d, user_id) for d in chunk]
-
+        def _classifica_chunk(chunk: list[str]):
             if summary.get('ai_rate_limited'):
                 # Quota già esaurita su un chunk precedente: gli altri fallirebbero
                 # allo stesso modo, inutile ritentare.
-                remaining_reasons['quota_ai_esaurita'] += len(chunk)
-                remaining_descs.extend(chunk)
-                continue
-
+                return None
             try:
-                categories, confidences = classifica_via_worker_con_confidenza(
+                return classifica_via_worker_con_confidenza(
                     chunk,
-                    fornitori=fornitori,
-                    iva=iva,
-                    hint=hint,
+                    fornitori=[desc_map[d]['fornitore'] for d in chunk],
+                    iva=[desc_map[d]['iva'] for d in chunk],
+                    hint=[ottieni_hint_per_ai(d, user_id) for d in chunk],
                     user_id=user_id,
                     ristorante_id=ristorante_id,
                 )
@@ -653,12 +642,27 @@ def _run_post_upload_ai_categorization(supabase_client, user_id: str, file_names
                 # detta, altrimenti è diagnosticabile solo dai log del server.
                 logger.warning(f"[UPLOAD AI] Quota giornaliera esaurita: {quota_exc}")
                 summary['ai_rate_limited'] = True
-                categories = ['Da Classificare'] * len(chunk)
-                confidences = ['bassa'] * len(chunk)
             except Exception as ai_exc:
                 logger.warning(f"[UPLOAD AI] Fallback AI fallito: {ai_exc}")
-                categories = ['Da Classificare'] * len(chunk)
-                confidences = ['bassa'] * len(chunk)
+            return ['Da Classificare'] * len(chunk), ['bassa'] * len(chunk)
+
+        # Chunk (max 30, piu' piccoli se le descrizioni sono lunghe) inviati in
+        # parallelo entro i limiti OpenAI: un upload da 600 righe non aspetta piu'
+        # 20 round-trip in serie. I risultati arrivano man mano che i chunk
+        # finiscono e si salvano subito (scritture DB restano in questo thread).
+        # Il primo chunk va da solo: se la quota e' esaurita lo si scopre con una
+        # richiesta, non con una per thread.
+        for chunk, esito, _errore in esegui_in_parallelo(
+            dimensiona_batch(descs_for_ai, max_articoli=30), _classifica_chunk, primo_da_solo=True,
+        ):
+            ai_memory_upserts = []
+            chunk_update_groups: dict[tuple[str, bool], list[int]] = {}
+
+            if esito is None:
+                remaining_reasons['quota_ai_esaurita'] += len(chunk)
+                remaining_descs.extend(chunk)
+                continue
+            categories, confidences = esito
 
             for desc, categoria, confidence in zip(chunk, categories, confidences):
                 categoria_finale = str(categoria or '').strip() or 'Da Classificare'
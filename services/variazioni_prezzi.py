@@ -0,0 +1,245 @@
+"""Motore vettoriale delle variazioni prezzo per coppia (prodotto, fornitore).
+
+Problema: /api/prezzi/variazioni, lo score fornitori e l'alert prezzi della
+Home (db_service.calcola_alert, usato da price_impact_service) facevano un
+`groupby` in Python sulle coppie (prodotto, fornitore). Per ogni gruppo
+riordinavano le righe, calcolavano `mode()`, parsavano le date una riga alla
+volta e costruivano lo storico. Sulla sede piu' grande erano secondi di CPU,
+e lo score fornitori rifaceva tutto sulle stesse righe.
+
+Qui le righe si ordinano una volta sola per (prodotto, fornitore, data).
+Ultimo e penultimo prezzo, medie, quantita', frequenza d'acquisto e trend si
+ricavano con operazioni a segmenti NumPy/pandas su tutto il frame: il
+risultato e' un riepilogo per gruppo (`BaseVariazioni`). Le parti testuali
+(storico, descrizione e fornitore prevalenti) si costruiscono solo per i
+gruppi oltre soglia (`selezione`).
+
+Le due letture storiche restano distinte: variazioni/score usano media e
+quantita' su tutti gli acquisti e la frequenza sull'arco del periodo,
+calcola_alert usa gli ultimi 5 prezzi, le ultime 3 quantita' e gli intervalli
+tra gli ultimi 4 acquisti. Il riepilogo le espone entrambe; ogni chiamante
+sceglie le sue colonne.
+"""
+
+from __future__ import annotations
+
+import sys
+from dataclasses import dataclass
+from itertools import groupby
+from operator import itemgetter
+from typing import Optional
+
+import numpy as np
+import pandas as pd
+
+# Variazioni tra acquisti consecutivi sotto questa soglia non contano nel trend.
+_EPS_TREND = 0.0001
+# Penultimo -> ultimo acquisto oltre questi giorni: confronto "stagionale".
+_GIORNI_STAGIONALE = 180
+
+TREND_SALITA_FORTE = "salita_forte"
+TREND_DISCESA_FORTE = "discesa_forte"
+TREND_OSCILLANTE = "oscillante"
+TREND_SALITA = "salita"
+TREND_DISCESA = "discesa"
+
+
+@dataclass
+class BaseVariazioni:
+    """Acquisti ordinati per (prodotto, fornitore, data) e riepilogo per gruppo.
+
+    `acquisti`: una riga per acquisto valido, colonne originali piu' `_desc_key`,
+    `_forn_key`, `_gid` (codice gruppo, crescente nell'ordine delle chiavi) e
+    `_dalla_fine` (0 = ultimo acquisto del gruppo).
+    `gruppi`: una riga per gruppo con almeno due acquisti, indicizzata per `_gid`.
+    """
+    acquisti: pd.DataFrame
+    gruppi: pd.DataFrame
+    prezzo: str = "prezzo_unitario"
+
+    def nbytes(self) -> int:
+        """Stima per i tetti di utils/ttl_cache: colonne object da un campione."""
+        totale = 0
+        for df in (self.acquisti, self.gruppi):
+            totale += int(df.memory_usage(index=True, deep=False).sum())
+            for col in df.columns[df.dtypes == object]:
+                campione = df[col].head(64)
+                if len(campione):
+                    totale += int(campione.map(sys.getsizeof).mean() * len(df))
+        return totale
+
+
+def chiave(serie: pd.Series) -> pd.Series:
+    """UPPER+TRIM: la stessa normalizzazione delle chiavi di raggruppamento storiche."""
+    return serie.astype(str).str.strip().str.upper()
+
+
+def _medie_per_gruppo(gid: np.ndarray, valori: np.ndarray, maschera: np.ndarray, n_gruppi: int) -> np.ndarray:
+    """Media per gruppo dei `valori` dove `maschera` (NaN se il gruppo non ne ha)."""
+    conta = np.bincount(gid[maschera], minlength=n_gruppi)
+    somma = np.bincount(gid[maschera], weights=valori[maschera], minlength=n_gruppi)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return np.where(conta > 0, somma / np.maximum(conta, 1), np.nan)
+
+
+def prepara(
+    acquisti: pd.DataFrame,
+    *,
+    descrizione: str,
+    fornitore: str,
+    data: str,
+    prezzo: str,
+    quantita: Optional[str] = None,
+) -> BaseVariazioni:
+    """Ordina gli acquisti (prezzo > 0 gia' filtrato dal chiamante) e riepiloga i gruppi.
+
+    Colonne del riepilogo: inizio/fine (posizioni in `acquisti`), n, prezzo_ult,
+    prezzo_pen, delta, var_pct, stagionale, trend, media_tutti, media_ult5,
+    qta_media_tutti, qta_media_ult3, freq_periodo, freq_intervalli.
+    """
+    df = acquisti.copy()
+    df["_desc_key"] = chiave(df[descrizione])
+    df["_forn_key"] = chiave(df[fornitore])
+    # Stabile: a parita' di data resta l'ordine di arrivo delle righe.
+    df = df.sort_values(["_desc_key", "_forn_key", data], kind="mergesort").reset_index(drop=True)
+    n_righe = len(df)
+    if n_righe == 0:
+        df["_gid"] = pd.Series(dtype="int64")
+        df["_dalla_fine"] = pd.Series(dtype="int64")
+        return BaseVariazioni(df, pd.DataFrame(), prezzo)
+
+    dk = df["_desc_key"].to_numpy()
+    fk = df["_forn_key"].to_numpy()
+    nuovo = np.ones(n_righe, dtype=bool)
+    nuovo[1:] = (dk[1:] != dk[:-1]) | (fk[1:] != fk[:-1])
+    gid = np.cumsum(nuovo) - 1
+    df["_gid"] = gid
+    inizio = np.flatnonzero(nuovo)
+    fine = np.append(inizio[1:], n_righe)
+    n = fine - inizio
+    n_gruppi = len(inizio)
+
+    pos = np.arange(n_righe)
+    dalla_fine = fine[gid] - 1 - pos
+    df["_dalla_fine"] = dalla_fine
+    dall_inizio = pos - inizio[gid]
+
+    prezzi = pd.to_numeric(df[prezzo], errors="coerce").to_numpy(dtype=float)
+    date = pd.to_datetime(df[data], errors="coerce", utc=True)
+    date_ns = date.to_numpy(dtype="datetime64[ns]")
+    data_valida = ~np.isnat(date_ns)
+
+    validi = n >= 2
+    ult = np.where(validi, fine - 1, 0)
+    pen = np.where(validi, fine - 2, 0)
+    prezzo_ult = prezzi[ult]
+    prezzo_pen = prezzi[pen]
+    delta = prezzo_ult - prezzo_pen
+    with np.errstate(invalid="ignore", divide="ignore"):
+        var_pct = delta / prezzo_pen * 100
+
+    giorni_ult_pen = (date_ns[ult] - date_ns[pen]).astype("timedelta64[D]").astype("int64")
+    stagionale = data_valida[ult] & data_valida[pen] & (giorni_ult_pen > _GIORNI_STAGIONALE)
+
+    # Trend: variazioni tra gli ultimi 4 acquisti (al piu' 3), ignorando le nulle.
+    variazione = np.zeros(n_righe)
+    variazione[1:] = prezzi[1:] - prezzi[:-1]
+    nel_trend = (dall_inizio >= 1) & (dalla_fine < 3)
+    salite = np.bincount(gid, weights=(nel_trend & (variazione > _EPS_TREND)), minlength=n_gruppi)
+    discese = np.bincount(gid, weights=(nel_trend & (variazione < -_EPS_TREND)), minlength=n_gruppi)
+    trend = np.select(
+        [salite >= 3, discese >= 3, (salite > 0) & (discese > 0), delta > 0, delta < 0],
+        [TREND_SALITA_FORTE, TREND_DISCESA_FORTE, TREND_OSCILLANTE, TREND_SALITA, TREND_DISCESA],
+        default=TREND_OSCILLANTE,
+    )
+
+    tutte = np.ones(n_righe, dtype=bool)
+    media_tutti = _medie_per_gruppo(gid, prezzi, tutte, n_gruppi)
+    media_ult5 = _medie_per_gruppo(gid, prezzi, dalla_fine < 5, n_gruppi)
+
+    if quantita is not None and quantita in df.columns:
+        qta = pd.to_numeric(df[quantita], errors="coerce").to_numpy(dtype=float)
+    else:
+        qta = np.full(n_righe, np.nan)
+    qta_ok = ~np.isnan(qta)
+    qta_media_tutti = _medie_per_gruppo(gid, qta, qta_ok, n_gruppi)
+    qta_media_ult3 = _medie_per_gruppo(gid, qta, qta_ok & (dalla_fine < 3), n_gruppi)
+
+    # Frequenza sull'arco del periodo: acquisti con data / mesi tra prima e ultima.
+    date_s = pd.Series(date_ns, index=gid)
+    per_gruppo = date_s.groupby(level=0).agg(["min", "max", "count"]).reindex(range(n_gruppi))
+    arco = (per_gruppo["max"] - per_gruppo["min"]).dt.days.to_numpy(dtype=float)
+    n_date = per_gruppo["count"].fillna(0).to_numpy(dtype=float)
+    freq_periodo = np.where(n_date >= 2, n_date / np.maximum(1.0, arco / 30.0), 1.0)
+
+    # Frequenza dagli intervalli tra gli ultimi 4 acquisti (giorni > 0), in [1, 6].
+    recenti = pd.DataFrame({"g": gid, "d": date_ns})[(dalla_fine < 4) & data_valida]
+    recenti = recenti.sort_values(["g", "d"], kind="mergesort")
+    intervalli = recenti["d"].diff().dt.days
+    intervalli = intervalli[(recenti["g"] == recenti["g"].shift()) & (intervalli > 0)]
+    media_intervalli = (
+        intervalli.groupby(recenti["g"][intervalli.index]).mean().reindex(range(n_gruppi)).to_numpy(dtype=float)
+    )
+    with np.errstate(invalid="ignore", divide="ignore"):
+        freq_intervalli = np.where(
+            np.isnan(media_intervalli), 1.0, np.clip(30.0 / media_intervalli, 1.0, 6.0)
+        )
+
+    gruppi = pd.DataFrame({
+        "inizio": inizio,
+        "fine": fine,
+        "n": n,
+        "prezzo_ult": prezzo_ult,
+        "prezzo_pen": prezzo_pen,
+        "delta": delta,
+        "var_pct": var_pct,
+        "stagionale": stagionale,
+        "trend": trend,
+        "media_tutti": media_tutti,
+        "media_ult5": media_ult5,
+        "qta_media_tutti": qta_media_tutti,
+        "qta_media_ult3": qta_media_ult3,
+        "freq_periodo": freq_periodo,
+        "freq_intervalli": freq_intervalli,
+    })
+    return BaseVariazioni(df, gruppi[validi], prezzo)
+
+
+def prevalenti(righe: pd.DataFrame, colonna: str, gid: pd.Series) -> pd.Series:
+    """Valore piu' frequente di `colonna` per gruppo, a parita' il minore (come `mode()[0]`)."""
+    conta = (
+        pd.DataFrame({"g": gid.to_numpy(), "v": righe[colonna].to_numpy()})
+        .dropna()
+        .value_counts()
+        .rename("c")
+        .reset_index()
+        .sort_values(["g", "c", "v"], ascending=[True, False, True], kind="mergesort")
+    )
+    return conta.drop_duplicates("g").set_index("g")["v"]
+
+
+def selezione(base: BaseVariazioni, soglia: float, *, n_storico: int = 5) -> pd.DataFrame:
+    """Gruppi con |variazione| >= soglia, con lo storico degli ultimi prezzi.
+
+    Colonne aggiunte: `storico` ("€a → €b ...", ultimi `n_storico` prezzi) e
+    `riga_ult` (indice in base.acquisti dell'ultimo acquisto). Ordine: quello
+    delle chiavi (prodotto, fornitore), come il vecchio groupby.
+    """
+    gruppi = base.gruppi
+    if gruppi.empty:
+        return gruppi.assign(storico=pd.Series(dtype=str), riga_ult=pd.Series(dtype="int64"))
+    sel = gruppi[np.abs(gruppi["var_pct"].to_numpy()) >= soglia].copy()
+    sel["riga_ult"] = sel["fine"] - 1
+    if sel.empty:
+        return sel.assign(storico=pd.Series(dtype=str))
+
+    acq = base.acquisti
+    coda = acq["_gid"].isin(sel.index) & (acq["_dalla_fine"] < n_storico)
+    prezzi = pd.to_numeric(acq.loc[coda, base.prezzo], errors="coerce").tolist()
+    # Righe gia' contigue per gruppo e in ordine di data: basta spezzarle.
+    storico = {
+        g: " → ".join(f"€{p:.2f}" for _, p in righe)
+        for g, righe in groupby(zip(acq.loc[coda, "_gid"].tolist(), prezzi), key=itemgetter(0))
+    }
+    sel["storico"] = sel.index.map(storico)
+    return sel
@@ -11,13 +11,29 @@ per capire l'andamento. Non è un sistema di osservabilità completo, è una spi
 
 Uso: il middleware chiama `record(route, ms, status)` a ogni richiesta; l'endpoint
 admin chiama `snapshot()` per leggere l'aggregato.
+
+Estrazione P7M: `record_p7m(metodo, piva, ms)` conta quale strategia ha aperto la
+busta (o None se nessuna), in totale e per P.IVA del fornitore. Gli stessi
+contatori servono a estrai_xml_da_p7m per riordinare i ripieghi
+(`p7m_conteggi`) e compaiono in `snapshot()["p7m"]`.
+
+Quote AI: `snapshot()["ai_quota"]` riporta i contatori giornalieri di
+services/ai_quota (lotto locale, concesse/rifiutate, ripieghi sul COUNT).
+
+Token di accesso: `snapshot()["session_token"]` riporta lo stato delle revoche
+di services/session_token (voci in memoria, sincronizzazioni, errori).
+
+Cache in-process: `snapshot()["cache"]` elenca le TTLCache con nome
+(utils/ttl_cache) con voci, byte stimati, hit/miss, evictions e scadute.
+`snapshot()["cache_bus"]` riporta gli eventi di invalidazione scambiati con
+gli altri processi (services/cache_bus).
 """
 
 from __future__ import annotations
 
 import threading
-from collections import deque
-from typing import Deque, Dict, List, Tuple
+from collections import Counter, OrderedDict, deque
+from typing import Deque, Dict, List, Optional, Tuple
 
 # Quanti campioni per rotta tenere (finestra scorrevole). ~500 basta per p95 stabile
 # senza consumo di memoria significativo.
@@ -28,6 +44,9 @@ _MAX_SAMPLES = 500
 # la schermata "non raggiungibile".
 SLOW_MS = 4000
 
+# Fornitori tracciati per l'estrazione P7M (LRU): oltre, si dimentica il meno recente.
+_MAX_FORNITORI_P7M = 2000
+
 
 class _RouteStats:
     __slots__ = ("samples", "count", "slow", "errors", "max_ms")
@@ -43,6 +62,10 @@ class _RouteStats:
 _stats: Dict[str, _RouteStats] = {}
 _lock = threading.Lock()
 
+# metodo → [conteggio, ms totali]; chiave None = nessuna strategia riuscita.
+_p7m_metodi: Dict[Optional[str], List[float]] = {}
+_p7m_fornitori: "OrderedDict[str, Counter]" = OrderedDict()
+
 
 def record(route: str, ms: float, status: int) -> None:
     with _lock:
@@ -60,6 +83,44 @@ def record(route: str, ms: float, status: int) -> None:
             st.max_ms = ms
 
 
+def record_p7m(metodo: Optional[str], piva: Optional[str], ms: float) -> None:
+    with _lock:
+        voce = _p7m_metodi.setdefault(metodo, [0, 0.0])
+        voce[0] += 1
+        voce[1] += ms
+        if piva and metodo:
+            conteggi = _p7m_fornitori.pop(piva, None) or Counter()
+            conteggi[metodo] += 1
+            _p7m_fornitori[piva] = conteggi
+            while len(_p7m_fornitori) > _MAX_FORNITORI_P7M:
+                _p7m_fornitori.popitem(last=False)
+
+
+def p7m_conteggi(piva: Optional[str] = None) -> Dict[str, int]:
+    """Successi per metodo: del fornitore `piva` (vuoto se mai visto) o globali."""
+    with _lock:
+        if piva is not None:
+            return dict(_p7m_fornitori.get(piva) or {})
+        return {m: int(v[0]) for m, v in _p7m_metodi.items() if m is not None}
+
+
+def _p7m_snapshot() -> Dict[str, object]:
+    metodi = [
+        {"metodo": m or "fallito", "count": int(v[0]), "media_ms": round(v[1] / v[0], 1) if v[0] else 0.0}
+        for m, v in _p7m_metodi.items()
+    ]
+    metodi.sort(key=lambda r: r["count"], reverse=True)
+    # In evidenza i fornitori che hanno avuto bisogno di un ripiego: sono quelli
+    # da guardare (busta fuori standard) e quelli per cui l'ordine si adatta.
+    ripieghi = [
+        {"piva": piva, "metodi": dict(c)}
+        for piva, c in _p7m_fornitori.items()
+        if any(m != "der" for m in c)
+    ]
+    ripieghi.sort(key=lambda r: sum(n for m, n in r["metodi"].items() if m != "der"), reverse=True)
+    return {"metodi": metodi, "fornitori": len(_p7m_fornitori), "fornitori_con_ripiego": ripieghi[:50]}
+
+
 def _percentile(sorted_vals: List[float], pct: float) -> float:
     if not sorted_vals:
         return 0.0
@@ -93,14 +154,42 @@ def snapshot() -> Dict[str, object]:
             tot_count += st.count
             tot_slow += st.slow
             tot_errors += st.errors
+        p7m = _p7m_snapshot()
     rows.sort(key=lambda r: r["p95_ms"], reverse=True)
+    try:
+        from services import ai_quota
+        quota = ai_quota.stato()
+    except Exception:
+        quota = []
+    try:
+        from services import session_token
+        token_accesso = session_token.stato()
+    except Exception:
+        token_accesso = {}
+    try:
+        from utils.ttl_cache import statistiche
+        cache = statistiche()
+    except Exception:
+        cache = []
+    try:
+        from services import cache_bus
+        bus = cache_bus.stato()
+    except Exception:
+        bus = {}
     return {
         "routes": rows,
         "totale": {"count": tot_count, "slow": tot_slow, "errors": tot_errors},
         "slow_soglia_ms": SLOW_MS,
+        "p7m": p7m,
+        "ai_quota": quota,
+        "session_token": token_accesso,
+        "cache": cache,
+        "cache_bus": bus,
     }
 
 
 def reset() -> None:
     with _lock:
         _stats.clear()
+        _p7m_metodi.clear()
+        _p7m_fornitori.clear()
@@ -198,6 +198,26 @@ export async function verifyHmac(
   return timingSafeEqual(hex, sig)
 }
 
+// ─── Utility: sveglia del queue-worker (services/queue_wakeup.py) ─────────────
+// Dopo l'accodamento avvisa il queue-worker che c'è lavoro, così non aspetta il
+// prossimo giro di polling. Best-effort e mai bloccante oltre 1s: se la sveglia
+// si perde il worker trova comunque la riga al polling di sicurezza. No-op se
+// QUEUE_WORKER_WAKEUP_URL / QUEUE_WORKER_WAKEUP_KEY non sono configurati.
+export async function svegliaQueueWorker(coda: 'fatture' | 'email'): Promise<void> {
+  const base = (Deno.env.get('QUEUE_WORKER_WAKEUP_URL') ?? '').replace(/\/+$/, '')
+  const key  = Deno.env.get('QUEUE_WORKER_WAKEUP_KEY') ?? ''
+  if (!base || !key) return
+  try {
+    await fetch(`${base}/sveglia/${coda}`, {
+      method:  'POST',
+      headers: { 'X-Worker-Key': key },
+      signal:  AbortSignal.timeout(1000),
+    })
+  } catch (err) {
+    console.warn(`[wakeup] sveglia ${coda} fallita (non bloccante): ${err instanceof Error ? err.message : String(err)}`)
+  }
+}
+
 // ─── Utility: alert Telegram immediato (Voce 7 / Strato 1, 28/7/2026) ─────────
 // Quando un evento firmato non viene riconosciuto come "receive" valido (rete
 // di sicurezza sopra), la fattura resta comunque visibile in coda come
@@ -1392,6 +1412,8 @@ async function processaEvento(
   }
 
   console.info(`[wh] Accodato event_id=${eventId} status=${status} piva=${pivaRaw}`)
+  // Solo le righe claimabili: 'da_assegnare' aspetta l'admin, non il worker.
+  if (status === 'pending') await svegliaQueueWorker('fatture')
 
   // ── 10. Evento accodato ────────────────────────────────────────────────────
   // L'handler risponde 200 se nessun evento del body ha chiesto il retry.
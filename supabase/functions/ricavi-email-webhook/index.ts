@@ -114,6 +114,26 @@ export function hasXlsMagicBytes(bytes: Uint8Array): boolean {
   return ole2.every((b, i) => bytes[i] === b)
 }
 
+// ─── Utility: sveglia del queue-worker (services/queue_wakeup.py) ─────────────
+// Dopo l'accodamento avvisa il queue-worker che c'è lavoro, così non aspetta il
+// prossimo giro di polling. Best-effort e mai bloccante oltre 1s: se la sveglia
+// si perde il worker trova comunque la riga al polling di sicurezza. No-op se
+// QUEUE_WORKER_WAKEUP_URL / QUEUE_WORKER_WAKEUP_KEY non sono configurati.
+export async function svegliaQueueWorker(coda: 'fatture' | 'email'): Promise<void> {
+  const base = (Deno.env.get('QUEUE_WORKER_WAKEUP_URL') ?? '').replace(/\/+$/, '')
+  const key  = Deno.env.get('QUEUE_WORKER_WAKEUP_KEY') ?? ''
+  if (!base || !key) return
+  try {
+    await fetch(`${base}/sveglia/${coda}`, {
+      method:  'POST',
+      headers: { 'X-Worker-Key': key },
+      signal:  AbortSignal.timeout(1000),
+    })
+  } catch (err) {
+    console.warn(`[email-wh] sveglia ${coda} fallita (non bloccante): ${err instanceof Error ? err.message : String(err)}`)
+  }
+}
+
 // Alert Telegram non bloccante — stesso pattern di
 // invoicetronic-webhook.notifyTelegramUnrecognizedEvent: silenzioso se i secret
 // non sono configurati, mai propaga errori. Serve perché i due modi in cui i
@@ -309,6 +329,7 @@ export const handler = async (req: Request): Promise<Response> => {
 
   // Errori DB accumulati: il ciclo non si interrompe, l'esito si decide alla fine.
   const erroriDb: string[] = []
+  let accodatiPending = 0
 
   for (const item of items) {
     const senderEmail = (item.From?.Address ?? '').trim().toLowerCase()
@@ -469,9 +490,13 @@ export const handler = async (req: Request): Promise<Response> => {
       }
 
       console.info(`[email-wh] Accodato ${filename} da ${senderEmail} status=${status}`)
+      if (status === 'pending') accodatiPending++
     }
   }
 
+  // Una sola sveglia per richiesta, anche con più allegati.
+  if (accodatiPending > 0) await svegliaQueueWorker('email')
+
   if (erroriDb.length > 0) {
     await notifyTelegram([
       '🔴 Ricavi email: errori DB in accodamento',
@@ -0,0 +1,93 @@
+-- ═══════════════════════════════════════════════════════════════════════════════
+-- Migration: watermark updated_at sulle tabelle memoria + chiave cache_version per i DELETE
+-- ═══════════════════════════════════════════════════════════════════════════════
+-- PERFORMANCE: ogni bump di cache_version('memoria_classificazione') faceva buttare
+-- e riscaricare a OGNI processo l'intera memoria globale (prodotti_master +
+-- classificazioni_manuali, decine di migliaia di righe paginate) e le mappe
+-- prodotti_utente di tutti gli utenti caricati. Una singola correzione admin
+-- costava N scansioni complete.
+--
+-- Ora ai_service.carica_memoria_completa applica un DELTA: scarica solo le righe
+-- con updated_at >= watermark (cache_version.updated_at dell'ultima versione
+-- applicata, meno una finestra di sovrapposizione) e patcha le mappe in place.
+-- Servono due cose lato DB:
+--
+-- 1) `updated_at` affidabile su tutte e tre le tabelle, mantenuto da trigger
+--    (prodotti_master aveva solo `ultima_modifica`, non aggiornata dagli update
+--    di streak; classificazioni_manuali solo `created_at`; prodotti_utente
+--    l'aveva ma valorizzata dal client). Indice (updated_at, id) per la
+--    paginazione keyset del delta.
+--
+-- 2) I DELETE non sono visibili a un delta per watermark: il trigger di bump,
+--    su DELETE, incrementa ANCHE la chiave 'memoria_classificazione_delete'.
+--    Il client che vede cambiare quella chiave fa il reload completo come prima.
+--
+-- Compatibile all'indietro: un client vecchio legge solo 'memoria_classificazione'
+-- e continua a fare il reload completo; un client nuovo senza questa migration
+-- non trova la chiave _delete e non tenta il delta.
+-- ═══════════════════════════════════════════════════════════════════════════════
+
+-- ---------- 1) Colonne + trigger updated_at ----------
+alter table public.prodotti_master
+    add column if not exists updated_at timestamptz not null default now();
+alter table public.classificazioni_manuali
+    add column if not exists updated_at timestamptz not null default now();
+alter table public.prodotti_utente
+    add column if not exists updated_at timestamptz default now();
+
+create or replace function public.fn_memoria_set_updated_at()
+returns trigger
+language plpgsql
+set search_path = public
+as $$
+begin
+    new.updated_at = now();
+    return new;
+end;
+$$;
+
+drop trigger if exists trg_memoria_updated_at_pm on public.prodotti_master;
+create trigger trg_memoria_updated_at_pm
+before insert or update on public.prodotti_master
+for each row execute function public.fn_memoria_set_updated_at();
+
+drop trigger if exists trg_memoria_updated_at_cm on public.classificazioni_manuali;
+create trigger trg_memoria_updated_at_cm
+before insert or update on public.classificazioni_manuali
+for each row execute function public.fn_memoria_set_updated_at();
+
+drop trigger if exists trg_memoria_updated_at_pu on public.prodotti_utente;
+create trigger trg_memoria_updated_at_pu
+before insert or update on public.prodotti_utente
+for each row execute function public.fn_memoria_set_updated_at();
+
+create index if not exists idx_prodotti_master_updated_at_id
+    on public.prodotti_master (updated_at, id);
+create index if not exists idx_classificazioni_manuali_updated_at_id
+    on public.classificazioni_manuali (updated_at, id);
+create index if not exists idx_prodotti_utente_updated_at_id
+    on public.prodotti_utente (updated_at, id);
+
+-- ---------- 2) Chiave separata per i DELETE ----------
+insert into public.cache_version(key, version)
+values ('memoria_classificazione_delete', 1)
+on conflict (key) do nothing;
+
+create or replace function public.fn_bump_cache_version()
+returns trigger
+language plpgsql
+security definer
+set search_path = public
+as $$
+begin
+    update public.cache_version
+        set version = version + 1,
+            updated_at = now()
+    where key = 'memoria_classificazione'
+       or (tg_op = 'DELETE' and key = 'memoria_classificazione_delete');
+    return null;
+end;
+$$;
+
+revoke all on function public.fn_bump_cache_version() from public, anon, authenticated;
+grant execute on function public.fn_bump_cache_version() to service_role;
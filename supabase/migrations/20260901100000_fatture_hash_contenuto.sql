@@ -0,0 +1,28 @@
+-- ═══════════════════════════════════════════════════════════════════════════════
+-- Migration: registro hash contenuto delle fatture elaborate (dedup per contenuto)
+-- ═══════════════════════════════════════════════════════════════════════════════
+-- PERFORMANCE: durante l'onboarding dello storico (cartelle ricaricate, stesso
+-- documento arrivato da SDI e poi caricato a mano con un altro nome) ogni copia
+-- rifaceva parse, salvataggio e passaggio AI prima di essere scartata come
+-- duplicato. services/dedup_contenuto registra qui, dopo un salvataggio
+-- riuscito, lo SHA-256 dell'XML normalizzato: upload e queue-worker lo
+-- consultano PRIMA del parse e rispondono subito col file_origine esistente.
+--
+-- La chiave include la sede: lo stesso XML su un'altra sede e' un documento
+-- diverso. La riga non e' la fonte di verita': il client verifica sempre che su
+-- `fatture` ci sia ancora una riga attiva per file_origine, quindi una fattura
+-- eliminata si puo' ricaricare senza toccare questa tabella.
+-- ═══════════════════════════════════════════════════════════════════════════════
+
+create table if not exists public.fatture_hash_contenuto (
+    ristorante_id uuid not null references public.ristoranti(id) on delete cascade,
+    xml_sha256 text not null,
+    user_id uuid,
+    file_origine text not null,
+    righe integer not null default 0,
+    created_at timestamptz not null default now(),
+    primary key (ristorante_id, xml_sha256)
+);
+
+alter table public.fatture_hash_contenuto enable row level security;
+-- Nessuna policy pubblica: solo service_role bypassa RLS
@@ -0,0 +1,35 @@
+-- ═══════════════════════════════════════════════════════════════════════════════
+-- Migration: cache condivisa delle risposte GPT di categorizzazione
+-- ═══════════════════════════════════════════════════════════════════════════════
+-- PERFORMANCE: la stessa descrizione dello stesso fornitore arriva nella stessa
+-- settimana a decine di ristoranti e, finche' non e' promossa in
+-- prodotti_master, ognuno la pagava e la aspettava da capo su OpenAI.
+-- services/ai_risposte_cache salva qui la risposta GPT per articolo e
+-- classifica_con_ai la consulta PRIMA di comporre i batch.
+--
+-- `chiave` = SHA-256 di (descrizione normalizzata, fornitore, IVA, hint,
+-- versione prompt, modello): cambiare prompt o modello rende le voci vecchie
+-- irraggiungibili senza pulizie. Il TTL si applica in lettura su updated_at
+-- (ONEFLUX_AI_CACHE_TTL_GIORNI, default 30). token_stimati = quota per articolo
+-- dei token della chiamata che ha prodotto la risposta, usata per dichiarare in
+-- ai_usage_events i token risparmiati dagli hit.
+--
+-- Tabella globale (nessun ristorante_id): contiene solo descrizioni articolo e
+-- categorie, lo stesso tipo di dato gia' condiviso da prodotti_master.
+-- ═══════════════════════════════════════════════════════════════════════════════
+
+create table if not exists public.ai_risposte_cache (
+    chiave text primary key,
+    categoria text not null,
+    confidenza text not null default 'media',
+    token_stimati integer not null default 0,
+    modello text not null,
+    versione_prompt text not null,
+    updated_at timestamptz not null default now()
+);
+
+create index if not exists idx_ai_risposte_cache_updated_at
+    on public.ai_risposte_cache (updated_at);
+
+alter table public.ai_risposte_cache enable row level security;
+-- Nessuna policy pubblica: solo service_role bypassa RLS
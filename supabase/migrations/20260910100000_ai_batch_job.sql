@@ -0,0 +1,69 @@
+-- ═══════════════════════════════════════════════════════════════════════════════
+-- Migration: job batch notturni di classificazione AI + applicazione in bulk
+-- ═══════════════════════════════════════════════════════════════════════════════
+-- PERFORMANCE: l'agent notturno mandava il backlog 'da_verificare' a GPT con le
+-- stesse chat-completion sincrone degli upload e scriveva un upsert per
+-- descrizione. services/ai_batch_notturno lo trasforma in un job JSONL (Batch
+-- API OpenAI o runner locale a bassa priorita') e applica i risultati a blocchi.
+--
+-- 1) `ai_batch_job`: checkpoint del job. `richieste` = per ogni custom_id le
+--    descrizioni originali del batch (la risposta mappa per idx);
+--    `applicati` = custom_id gia' scritti in prodotti_master. Un riavvio
+--    riprende dal primo non applicato; un batch remoto non ancora pronto resta
+--    'inviato' e viene ripreso al giro successivo.
+--
+-- 2) `applica_suggerimenti_ai_bulk(p_voci jsonb)`: UNA chiamata per blocco di
+--    suggerimenti [{descrizione, categoria_suggerita, suggerito_at}], stessa
+--    semantica dell'upsert per riga di prepara_suggerimenti_ai (fonte 'ai',
+--    mai la categoria definitiva). Ritorna le righe scritte.
+-- ═══════════════════════════════════════════════════════════════════════════════
+
+create table if not exists public.ai_batch_job (
+    id text primary key,
+    stato text not null default 'preparato'
+        check (stato in ('preparato', 'inviato', 'applicato', 'fallito')),
+    runner text not null,
+    attore text,
+    id_remoto text,
+    richieste jsonb not null default '[]'::jsonb,
+    applicati jsonb not null default '[]'::jsonb,
+    errore text,
+    created_at timestamptz not null default now(),
+    updated_at timestamptz not null default now()
+);
+
+create index if not exists idx_ai_batch_job_aperti
+    on public.ai_batch_job (created_at desc)
+    where stato in ('preparato', 'inviato');
+
+alter table public.ai_batch_job enable row level security;
+-- Nessuna policy pubblica: solo service_role bypassa RLS
+
+create or replace function public.applica_suggerimenti_ai_bulk(p_voci jsonb)
+returns integer
+language plpgsql
+security definer
+set search_path = public
+as $$
+declare
+    v_righe integer;
+begin
+    insert into public.prodotti_master as pm
+        (descrizione, categoria_suggerita, suggerimento_fonte, suggerito_at)
+    select distinct on (v.descrizione)
+           v.descrizione, v.categoria_suggerita, 'ai', v.suggerito_at
+    from jsonb_to_recordset(coalesce(p_voci, '[]'::jsonb))
+         as v(descrizione text, categoria_suggerita text, suggerito_at timestamptz)
+    where coalesce(v.descrizione, '') <> ''
+      and coalesce(v.categoria_suggerita, '') <> ''
+    on conflict (descrizione) do update
+        set categoria_suggerita = excluded.categoria_suggerita,
+            suggerimento_fonte  = excluded.suggerimento_fonte,
+            suggerito_at        = excluded.suggerito_at;
+    get diagnostics v_righe = row_count;
+    return v_righe;
+end;
+$$;
+
+revoke all on function public.applica_suggerimenti_ai_bulk(jsonb) from public, anon, authenticated;
+grant execute on function public.applica_suggerimenti_ai_bulk(jsonb) to service_role;
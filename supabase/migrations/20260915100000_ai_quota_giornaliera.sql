@@ -0,0 +1,81 @@
+-- ═══════════════════════════════════════════════════════════════════════════════
+-- Migration: contatori quota AI giornaliera + prenotazione atomica (compare-and-increment)
+-- ═══════════════════════════════════════════════════════════════════════════════
+-- PERFORMANCE: classifica_con_ai e l'upload Vision facevano un COUNT(*) esatto
+-- su ai_usage_events (ristorante, giorno, operation_type) prima di OGNI batch
+-- AI: un round-trip e una scansione che cresce con l'uso della giornata. Il
+-- controllo "usati < limite" poi agire non era atomico: upload concorrenti a
+-- ridosso del limite lo superavano insieme.
+--
+-- services/ai_quota tiene i contatori in memoria e prenota a DB a LOTTI con
+-- `ai_quota_riserva`: un UPDATE condizionato (usati + n <= limite) sulla riga
+-- del giorno, che concede tutto o niente. La riga nasce alla prima
+-- prenotazione del giorno dal COUNT di ai_usage_events (una volta sola),
+-- cosi' gli eventi gia' registrati oggi restano la base.
+--
+-- p_limite NULL = integrazione senza limite (chiamate di retry gia' fatte).
+-- Le righe dei giorni passati non servono piu': pulizia con la retention
+-- (nessun impatto funzionale se restano).
+-- ═══════════════════════════════════════════════════════════════════════════════
+
+create table if not exists public.ai_quota_giornaliera (
+    ristorante_id uuid not null references public.ristoranti(id) on delete cascade,
+    giorno date not null,
+    famiglia text not null,
+    usati integer not null default 0,
+    updated_at timestamptz not null default now(),
+    primary key (ristorante_id, giorno, famiglia)
+);
+
+alter table public.ai_quota_giornaliera enable row level security;
+-- Nessuna policy pubblica: solo service_role bypassa RLS
+
+create or replace function public.ai_quota_riserva(
+    p_ristorante_id uuid,
+    p_famiglia text,
+    p_operation_types text[],
+    p_n integer,
+    p_limite integer default null
+)
+returns table (concessa boolean, usati integer)
+language plpgsql
+security definer
+set search_path = public
+as $$
+declare
+    v_giorno date := (now() at time zone 'utc')::date;
+    v_usati integer;
+begin
+    insert into public.ai_quota_giornaliera (ristorante_id, giorno, famiglia, usati)
+    select p_ristorante_id, v_giorno, p_famiglia, count(*)::integer
+    from public.ai_usage_events e
+    where e.ristorante_id = p_ristorante_id
+      and e.created_at >= (v_giorno::timestamp at time zone 'utc')
+      and e.operation_type = any (p_operation_types)
+    on conflict (ristorante_id, giorno, famiglia) do nothing;
+
+    update public.ai_quota_giornaliera q
+        set usati = q.usati + greatest(p_n, 0),
+            updated_at = now()
+    where q.ristorante_id = p_ristorante_id
+      and q.giorno = v_giorno
+      and q.famiglia = p_famiglia
+      and (p_limite is null or q.usati + greatest(p_n, 0) <= p_limite)
+    returning q.usati into v_usati;
+
+    if found then
+        return query select true, v_usati;
+        return;
+    end if;
+
+    select q.usati into v_usati
+    from public.ai_quota_giornaliera q
+    where q.ristorante_id = p_ristorante_id
+      and q.giorno = v_giorno
+      and q.famiglia = p_famiglia;
+    return query select false, coalesce(v_usati, 0);
+end;
+$$;
+
+revoke all on function public.ai_quota_riserva(uuid, text, text[], integer, integer) from public, anon, authenticated;
+grant execute on function public.ai_quota_riserva(uuid, text, text[], integer, integer) to service_role;
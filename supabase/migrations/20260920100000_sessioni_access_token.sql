@@ -0,0 +1,27 @@
+-- ═══════════════════════════════════════════════════════════════════════════════
+-- Migration: revoche dei token di accesso firmati (sessioni.access_non_prima_di)
+-- ═══════════════════════════════════════════════════════════════════════════════
+-- PERFORMANCE: services/session_token emette, per una sessione valida di
+-- `sessioni`, un token HMAC a vita breve che il worker verifica senza query.
+-- Prima ogni richiesta con la cache fredda costava un lookup su sessioni,
+-- una SELECT su users e una seconda SELECT su users per la sede attiva.
+--
+-- Un token emesso prima di max(revoked_at, access_non_prima_di) della sua
+-- sessione non vale piu'. Ogni processo worker legge, al piu' ogni pochi
+-- secondi, solo le righe con uno dei due timestamp recente (entro il TTL dei
+-- token): gli indici parziali sotto tengono la lettura su poche righe.
+--
+-- access_non_prima_di: il cambio sede attiva e le modifiche admin a pagine o
+-- stato account scartano i token gia' emessi SENZA revocare la sessione.
+-- ═══════════════════════════════════════════════════════════════════════════════
+
+alter table public.sessioni
+    add column if not exists access_non_prima_di timestamptz;
+
+create index if not exists idx_sessioni_revoked_at
+    on public.sessioni (revoked_at)
+    where revoked_at is not null;
+
+create index if not exists idx_sessioni_access_non_prima_di
+    on public.sessioni (access_non_prima_di)
+    where access_non_prima_di is not null;
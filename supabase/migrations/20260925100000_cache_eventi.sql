@@ -0,0 +1,33 @@
+-- ═══════════════════════════════════════════════════════════════════════════════
+-- Migration: bus di invalidazione cache tra processi (cache_eventi)
+-- ═══════════════════════════════════════════════════════════════════════════════
+-- PERFORMANCE: le cache in-process del worker (righe fatture/prezzi, KPI Home,
+-- statistiche dashboard) venivano invalidate solo nel processo che serviva la
+-- scrittura. Con WORKER_WEB_CONCURRENCY>1, e col queue-worker che salva le
+-- fatture in un altro processo, le altre copie restavano stantie fino al TTL,
+-- che per questo doveva restare corto.
+--
+-- services/cache_bus scrive qui un evento (dominio, ristorante_id, origine) per
+-- ogni invalidazione. Ogni processo legge gli eventi con id > ultimo visto
+-- (polling sulla chiave primaria, default ogni 2s) e pulisce solo le chiavi di
+-- quel ristorante. E' la generalizzazione di cache_version (una versione per
+-- chiave) a eventi mirati per sede; LISTEN/NOTIFY richiederebbe una connessione
+-- Postgres diretta, il worker usa solo PostgREST.
+--
+-- Gli eventi sono effimeri: i processi cancellano quelli piu' vecchi di un
+-- giorno (indice su created_at).
+-- ═══════════════════════════════════════════════════════════════════════════════
+
+create table if not exists public.cache_eventi (
+    id bigserial primary key,
+    dominio text not null,
+    ristorante_id text,
+    origine text not null,
+    created_at timestamptz not null default now()
+);
+
+create index if not exists idx_cache_eventi_created_at
+    on public.cache_eventi (created_at);
+
+alter table public.cache_eventi enable row level security;
+-- Nessuna policy pubblica: solo service_role bypassa RLS
@@ -0,0 +1,294 @@
+-- ═══════════════════════════════════════════════════════════════════════════════
+-- Migration: storico prezzi per (ristorante, prodotto, fornitore) — prezzi_storico
+-- ═══════════════════════════════════════════════════════════════════════════════
+-- PERFORMANCE: le letture prezzi (alert Home di price_impact_service, controlli
+-- di coerenza, script) riscansionavano le righe grezze di `fatture` del periodo
+-- per ricavare, per ogni coppia prodotto/fornitore, gli ultimi prezzi, la media
+-- e la frequenza d'acquisto. Qui quel riepilogo e' una tabella derivata con una
+-- riga per coppia: chi la legge paga O(prodotti), non O(righe fattura).
+--
+-- Chiave: (ristorante_id, UPPER(TRIM(descrizione)), UPPER(TRIM(fornitore))), la
+-- stessa normalizzazione del raggruppamento in services/variazioni_prezzi.
+-- Righe considerate: non cancellate, prezzo_unitario > 0, escluse le note di
+-- credito (stesso regex di _NC_TIPO_REGEX in routers/prezzi). Le categorie NON
+-- si filtrano qui: `categoria` e' quella dell'ultimo acquisto e ogni lettore
+-- applica le sue esclusioni (spese generali, ecc.).
+--
+-- Manutenzione come margini_mensili: la tabella si ricalcola dal DB, non dai
+-- chiamanti. Tre trigger per statement su fatture (insert, update, delete, con
+-- transition table) raccolgono le chiavi toccate e ricalcolano SOLO quelle:
+-- salvataggio fattura, soft delete singolo e massivo, ripristino dal cestino,
+-- cambio categoria, spostamento di sede passano tutti da qui, qualunque sia il
+-- percorso (worker, Streamlit, RPC). Un update che non tocca colonne lette
+-- dallo storico (es. needs_review) non ricalcola niente.
+--
+-- Ultimi 12 acquisti in ordine cronologico (a parita' di data, ordine di id):
+-- bastano alle letture "recenti" (ultimi 5 prezzi, ultime 3 quantita',
+-- intervalli tra gli ultimi 4 acquisti). Medie e frequenza sono su tutta la
+-- storia della coppia.
+--
+-- prezzi_storico_ricostruisci(ristorante) ricalcola da zero (comando di
+-- rebuild: scripts/prezzi_storico.py); il controllo di coerenza contro le righe
+-- grezze e' services/prezzi_storico.verifica_coerenza.
+-- ═══════════════════════════════════════════════════════════════════════════════
+
+create table if not exists public.prezzi_storico (
+    ristorante_id uuid not null,
+    descrizione_key text not null,
+    fornitore_key text not null,
+    user_id uuid,
+    descrizione text not null,
+    fornitore text not null,
+    categoria text,
+    n_acquisti integer not null,
+    prezzo_medio numeric not null,
+    quantita_media numeric,
+    prima_data date,
+    ultima_data date,
+    frequenza_mensile numeric not null,
+    ultimi_prezzi numeric[] not null,
+    ultime_date date[] not null,
+    ultime_quantita numeric[] not null,
+    ultimo_file text,
+    updated_at timestamptz not null default now(),
+    primary key (ristorante_id, descrizione_key, fornitore_key)
+);
+
+comment on table public.prezzi_storico is
+    'Riepilogo prezzi per (ristorante, prodotto, fornitore) mantenuto dai trigger su fatture. '
+    'ultimi_* = ultimi 12 acquisti in ordine cronologico. service_role (bypassa RLS).';
+
+create index if not exists idx_prezzi_storico_ultima_data
+    on public.prezzi_storico (ristorante_id, ultima_data);
+
+-- Ricalcolo di una chiave senza scansionare la sede: stesse espressioni del join.
+create index if not exists idx_fatture_chiave_prezzi_storico
+    on public.fatture (ristorante_id, upper(btrim(coalesce(descrizione, ''))), upper(btrim(coalesce(fornitore, ''))))
+    where deleted_at is null;
+
+alter table public.prezzi_storico enable row level security;
+-- Nessuna policy pubblica: solo service_role bypassa RLS
+revoke all on public.prezzi_storico from anon, authenticated;
+grant select, insert, update, delete on public.prezzi_storico to service_role;
+
+
+-- ---------- Ricalcolo delle chiavi indicate ----------
+-- Le tre liste sono parallele (ristorante, descrizione_key, fornitore_key).
+-- Le chiavi senza piu' acquisti validi si cancellano. Ritorna le righe scritte.
+create or replace function public.prezzi_storico_ricalcola(
+    p_ristoranti uuid[],
+    p_descrizioni text[],
+    p_fornitori text[]
+)
+returns integer
+language plpgsql
+security definer
+set search_path = public
+as $$
+declare
+    v_n integer;
+begin
+    delete from public.prezzi_storico s
+    using (
+        select distinct c.ristorante_id, c.descrizione_key, c.fornitore_key
+        from unnest(p_ristoranti, p_descrizioni, p_fornitori) as c(ristorante_id, descrizione_key, fornitore_key)
+    ) c
+    where s.ristorante_id = c.ristorante_id
+      and s.descrizione_key = c.descrizione_key
+      and s.fornitore_key = c.fornitore_key;
+
+    with chiavi as (
+        select distinct c.ristorante_id, c.descrizione_key, c.fornitore_key
+        from unnest(p_ristoranti, p_descrizioni, p_fornitori) as c(ristorante_id, descrizione_key, fornitore_key)
+        where c.ristorante_id is not null
+    ),
+    acquisti as (
+        select
+            c.ristorante_id, c.descrizione_key, c.fornitore_key,
+            f.user_id, f.descrizione, f.fornitore, f.categoria, f.file_origine,
+            f.prezzo_unitario::numeric as prezzo,
+            f.quantita::numeric as quantita,
+            f.data_documento as data,
+            -- 1 = ultimo acquisto. DESC mette le date nulle in testa, come il
+            -- sort pandas che le lascia in fondo all'ordine crescente.
+            row_number() over (
+                partition by c.ristorante_id, c.descrizione_key, c.fornitore_key
+                order by f.data_documento desc, f.id desc
+            ) as dalla_fine
+        from chiavi c
+        join public.fatture f
+          on f.ristorante_id = c.ristorante_id
+         and upper(btrim(coalesce(f.descrizione, ''))) = c.descrizione_key
+         and upper(btrim(coalesce(f.fornitore, ''))) = c.fornitore_key
+        where f.deleted_at is null
+          and f.prezzo_unitario > 0
+          and upper(coalesce(f.tipo_documento, '')) !~ 'TD04|NOTA DI CREDITO|NOTA CREDITO|\yNC\y|CREDIT'
+    )
+    insert into public.prezzi_storico (
+        ristorante_id, descrizione_key, fornitore_key, user_id, descrizione, fornitore,
+        categoria, n_acquisti, prezzo_medio, quantita_media, prima_data, ultima_data,
+        frequenza_mensile, ultimi_prezzi, ultime_date, ultime_quantita, ultimo_file, updated_at
+    )
+    select
+        ristorante_id, descrizione_key, fornitore_key,
+        (array_agg(user_id order by dalla_fine))[1],
+        -- mode(): a parita' di frequenza il primo nell'ordine, come prevalenti().
+        mode() within group (order by descrizione),
+        mode() within group (order by fornitore),
+        (array_agg(categoria order by dalla_fine))[1],
+        count(*)::integer,
+        avg(prezzo),
+        avg(quantita),
+        min(data),
+        max(data),
+        case
+            when count(data) >= 2
+            then count(data) / greatest(1.0, (max(data) - min(data)) / 30.0)
+            else 1.0
+        end,
+        array_agg(prezzo order by dalla_fine desc) filter (where dalla_fine <= 12),
+        array_agg(data order by dalla_fine desc) filter (where dalla_fine <= 12),
+        array_agg(quantita order by dalla_fine desc) filter (where dalla_fine <= 12),
+        (array_agg(file_origine order by dalla_fine))[1],
+        now()
+    from acquisti
+    group by ristorante_id, descrizione_key, fornitore_key;
+
+    get diagnostics v_n = row_count;
+    return v_n;
+end;
+$$;
+
+revoke all on function public.prezzi_storico_ricalcola(uuid[], text[], text[]) from public, anon, authenticated;
+grant execute on function public.prezzi_storico_ricalcola(uuid[], text[], text[]) to service_role;
+
+
+-- ---------- Trigger per statement su fatture ----------
+-- Un solo corpo per i tre trigger: ogni ramo legge solo le transition table
+-- che il suo trigger dichiara (plpgsql pianifica le query alla prima esecuzione).
+create or replace function public.fn_prezzi_storico_da_fatture()
+returns trigger
+language plpgsql
+security definer
+set search_path = public
+as $$
+declare
+    v_ristoranti uuid[];
+    v_descrizioni text[];
+    v_fornitori text[];
+begin
+    if tg_op = 'INSERT' then
+        select array_agg(k.r), array_agg(k.d), array_agg(k.f)
+          into v_ristoranti, v_descrizioni, v_fornitori
+        from (
+            select distinct n.ristorante_id,
+                   upper(btrim(coalesce(n.descrizione, ''))),
+                   upper(btrim(coalesce(n.fornitore, '')))
+            from nuove n
+            where n.ristorante_id is not null
+        ) k(r, d, f);
+    elsif tg_op = 'DELETE' then
+        select array_agg(k.r), array_agg(k.d), array_agg(k.f)
+          into v_ristoranti, v_descrizioni, v_fornitori
+        from (
+            select distinct o.ristorante_id,
+                   upper(btrim(coalesce(o.descrizione, ''))),
+                   upper(btrim(coalesce(o.fornitore, '')))
+            from vecchie o
+            where o.ristorante_id is not null
+        ) k(r, d, f);
+    else
+        -- UPDATE: solo le righe in cui cambia qualcosa che lo storico legge;
+        -- chiave vecchia e nuova (rinomina, cambio fornitore o sede).
+        with cambiate as (
+            select o.ristorante_id as r_old, o.descrizione as d_old, o.fornitore as f_old,
+                   n.ristorante_id as r_new, n.descrizione as d_new, n.fornitore as f_new
+            from vecchie o
+            join nuove n on n.id = o.id
+            where (o.ristorante_id, o.descrizione, o.fornitore, o.prezzo_unitario, o.quantita,
+                   o.data_documento, o.categoria, o.tipo_documento, o.deleted_at, o.file_origine, o.user_id)
+                  is distinct from
+                  (n.ristorante_id, n.descrizione, n.fornitore, n.prezzo_unitario, n.quantita,
+                   n.data_documento, n.categoria, n.tipo_documento, n.deleted_at, n.file_origine, n.user_id)
+        )
+        select array_agg(k.r), array_agg(k.d), array_agg(k.f)
+          into v_ristoranti, v_descrizioni, v_fornitori
+        from (
+            select r_old, upper(btrim(coalesce(d_old, ''))), upper(btrim(coalesce(f_old, '')))
+            from cambiate where r_old is not null
+            union
+            select r_new, upper(btrim(coalesce(d_new, ''))), upper(btrim(coalesce(f_new, '')))
+            from cambiate where r_new is not null
+        ) k(r, d, f);
+    end if;
+
+    if v_ristoranti is not null then
+        perform public.prezzi_storico_ricalcola(v_ristoranti, v_descrizioni, v_fornitori);
+    end if;
+    return null;
+end;
+$$;
+
+revoke all on function public.fn_prezzi_storico_da_fatture() from public, anon, authenticated;
+
+drop trigger if exists trg_prezzi_storico_ins on public.fatture;
+create trigger trg_prezzi_storico_ins
+after insert on public.fatture
+referencing new table as nuove
+for each statement execute function public.fn_prezzi_storico_da_fatture();
+
+drop trigger if exists trg_prezzi_storico_upd on public.fatture;
+create trigger trg_prezzi_storico_upd
+after update on public.fatture
+referencing old table as vecchie new table as nuove
+for each statement execute function public.fn_prezzi_storico_da_fatture();
+
+drop trigger if exists trg_prezzi_storico_del on public.fatture;
+create trigger trg_prezzi_storico_del
+after delete on public.fatture
+referencing old table as vecchie
+for each statement execute function public.fn_prezzi_storico_da_fatture();
+
+
+-- ---------- Rebuild ----------
+-- Ricalcola tutte le chiavi di un ristorante (o di tutti con NULL): quelle con
+-- righe vive in fatture e quelle gia' in tabella (che spariscono se orfane).
+create or replace function public.prezzi_storico_ricostruisci(p_ristorante_id uuid default null)
+returns integer
+language plpgsql
+security definer
+set search_path = public
+as $$
+declare
+    v_ristoranti uuid[];
+    v_descrizioni text[];
+    v_fornitori text[];
+begin
+    select array_agg(k.r), array_agg(k.d), array_agg(k.f)
+      into v_ristoranti, v_descrizioni, v_fornitori
+    from (
+        select f.ristorante_id,
+               upper(btrim(coalesce(f.descrizione, ''))),
+               upper(btrim(coalesce(f.fornitore, '')))
+        from public.fatture f
+        where f.deleted_at is null
+          and f.ristorante_id is not null
+          and (p_ristorante_id is null or f.ristorante_id = p_ristorante_id)
+        union
+        select s.ristorante_id, s.descrizione_key, s.fornitore_key
+        from public.prezzi_storico s
+        where p_ristorante_id is null or s.ristorante_id = p_ristorante_id
+    ) k(r, d, f);
+
+    if v_ristoranti is null then
+        return 0;
+    end if;
+    return public.prezzi_storico_ricalcola(v_ristoranti, v_descrizioni, v_fornitori);
+end;
+$$;
+
+revoke all on function public.prezzi_storico_ricostruisci(uuid) from public, anon, authenticated;
+grant execute on function public.prezzi_storico_ricostruisci(uuid) to service_role;
+
+-- Popolamento iniziale: i lettori trattano la tabella come completa.
+select public.prezzi_storico_ricostruisci();
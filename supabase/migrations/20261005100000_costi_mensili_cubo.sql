@@ -0,0 +1,525 @@
+-- ═══════════════════════════════════════════════════════════════════════════════
+-- Migration: cubo dei costi mensili per (ristorante, mese, categoria, fornitore)
+-- ═══════════════════════════════════════════════════════════════════════════════
+-- PERFORMANCE: il costo mensile di una sede si ricalcolava dalle righe grezze di
+-- `fatture` in sei punti diversi (costi auto della pagina Margini e del KPI Home,
+-- costi F&B per centro, RPC costi_automatici_mensili[_gruppo], fallback della
+-- dashboard, tool costi della chat), ognuno con la sua scansione paginata. Il
+-- costo cresceva col numero di righe del cliente, non col periodo chiesto.
+--
+-- Qui quel totale e' una tabella derivata con una riga per cella
+-- (ristorante, user, mese di competenza, mese documento, categoria, fornitore,
+-- fonte): leggere un anno costa O(categorie x fornitori x mesi), sempre con una
+-- discesa d'indice per sede.
+--
+-- Dimensioni:
+--   anno/mese          competenza = COALESCE(data_competenza, data_documento)
+--                      (margini, KPI Home, Gruppo);
+--   anno_doc/mese_doc  data_documento (dashboard, Analisi per centro, chat);
+--                      0/0 = riga senza data;
+--   categoria/fornitore grezzi, '' se NULL (le letture applicano trim/etichette);
+--   fonte              'fattura'   righe normali della sede,
+--                      'ripartita' righe con ripartita_su_gruppo (la sede tecnica
+--                                  le tiene, il MOL le esclude),
+--                      'quota'     quote dei costi di gruppo a carico del PV
+--                                  (riparto_costi_catena_quote), al mese del riparto.
+-- Misure: totale (somma con segno), totale_positivo (solo righe > 0, per le
+-- viste per centro che scartano gli storni), n_righe.
+-- Dentro ci sono tutte le righe vive, anche 'Da Classificare': ogni lettore
+-- applica le sue esclusioni come faceva sulle righe.
+--
+-- Manutenzione come prezzi_storico: la tabella si aggiorna dal DB, mai dai
+-- chiamanti. Trigger per statement su fatture (con transition table) applicano
+-- il delta delle sole righe cambiate: meno le vecchie, piu' le nuove. Upsert
+-- additivo, quindi due scritture concorrenti sulla stessa cella si sommano
+-- invece di sovrascriversi; le celle rimaste senza righe si cancellano.
+-- Salvataggio, soft delete, ripristino, cambio categoria o data di competenza e
+-- spostamento di sede passano tutti da qui. Le quote si ricalcolano per PV a
+-- ogni scrittura su riparto_costi_catena_quote o sul riparto padre (poche righe
+-- per sede).
+--
+-- costi_cubo_mensili() e' la lettura: una chiamata, celle aggregate per mese e
+-- categoria in un jsonb (nessun limite max_rows di PostgREST, nessuna pagina).
+-- costi_automatici_mensili[_gruppo] leggono ora dal cubo, firme invariate.
+-- costi_cubo_ricostruisci(ristorante) ricalcola da zero (scripts/costi_cubo.py);
+-- il confronto con le righe grezze e' services/costi_cubo.verifica_coerenza.
+-- ═══════════════════════════════════════════════════════════════════════════════
+
+create table if not exists public.costi_mensili_cubo (
+    ristorante_id uuid not null,
+    user_id uuid not null,
+    anno integer not null,
+    mese integer not null,
+    anno_doc integer not null,
+    mese_doc integer not null,
+    categoria text not null default '',
+    fornitore text not null default '',
+    fonte text not null check (fonte in ('fattura', 'ripartita', 'quota')),
+    totale numeric not null default 0,
+    totale_positivo numeric not null default 0,
+    n_righe integer not null default 0,
+    updated_at timestamptz not null default now(),
+    primary key (ristorante_id, anno, mese, anno_doc, mese_doc, categoria, fornitore, fonte, user_id)
+);
+
+comment on table public.costi_mensili_cubo is
+    'Costi mensili per (ristorante, mese competenza/documento, categoria, fornitore, fonte) '
+    'mantenuti dai trigger su fatture e riparto_costi_catena_quote. service_role (bypassa RLS).';
+
+-- La chiave primaria serve le letture per competenza; questo quelle per documento.
+create index if not exists idx_costi_cubo_documento
+    on public.costi_mensili_cubo (ristorante_id, anno_doc, mese_doc);
+
+alter table public.costi_mensili_cubo enable row level security;
+-- Nessuna policy pubblica: solo service_role bypassa RLS
+revoke all on public.costi_mensili_cubo from anon, authenticated;
+grant select, insert, update, delete on public.costi_mensili_cubo to service_role;
+
+
+-- ---------- Delta dalle righe fattura ----------
+-- Celle di un insieme di righe di fatture passate come jsonb (to_jsonb delle
+-- transition table). Righe cancellate o senza sede non contano.
+create or replace function public.costi_cubo_celle(p_righe jsonb)
+returns table (
+    ristorante_id uuid, user_id uuid, anno integer, mese integer, anno_doc integer, mese_doc integer,
+    categoria text, fornitore text, fonte text, totale numeric, totale_positivo numeric, n_righe integer
+)
+language sql
+immutable
+set search_path = public
+as $$
+    with righe as (
+        select
+            (r->>'ristorante_id')::uuid as ristorante_id,
+            (r->>'user_id')::uuid as user_id,
+            coalesce((r->>'data_competenza')::date, (r->>'data_documento')::date) as data_comp,
+            (r->>'data_documento')::date as data_doc,
+            coalesce(r->>'categoria', '') as categoria,
+            coalesce(r->>'fornitore', '') as fornitore,
+            case when coalesce((r->>'ripartita_su_gruppo')::boolean, false)
+                 then 'ripartita' else 'fattura' end as fonte,
+            coalesce((r->>'totale_riga')::numeric, 0) as totale
+        from jsonb_array_elements(p_righe) r
+        where r->>'deleted_at' is null
+          and r->>'ristorante_id' is not null
+          and r->>'user_id' is not null
+    )
+    select
+        ristorante_id, user_id,
+        coalesce(extract(year from data_comp)::integer, 0),
+        coalesce(extract(month from data_comp)::integer, 0),
+        coalesce(extract(year from data_doc)::integer, 0),
+        coalesce(extract(month from data_doc)::integer, 0),
+        categoria, fornitore, fonte,
+        sum(totale), sum(greatest(totale, 0)), count(*)::integer
+    from righe
+    group by 1, 2, 3, 4, 5, 6, 7, 8, 9;
+$$;
+
+revoke all on function public.costi_cubo_celle(jsonb) from public, anon, authenticated;
+
+-- Somma alle celle il delta delle righe (p_segno +1 le nuove, -1 le vecchie) e
+-- cancella quelle toccate rimaste senza righe. Ritorna le celle toccate.
+create or replace function public.costi_cubo_applica_righe(p_righe jsonb, p_segno integer)
+returns integer
+language plpgsql
+security definer
+set search_path = public
+as $$
+declare
+    v_n integer;
+begin
+    insert into public.costi_mensili_cubo as c (
+        ristorante_id, user_id, anno, mese, anno_doc, mese_doc, categoria, fornitore, fonte,
+        totale, totale_positivo, n_righe, updated_at
+    )
+    select d.ristorante_id, d.user_id, d.anno, d.mese, d.anno_doc, d.mese_doc,
+           d.categoria, d.fornitore, d.fonte,
+           p_segno * d.totale, p_segno * d.totale_positivo, p_segno * d.n_righe, now()
+    from public.costi_cubo_celle(p_righe) d
+    on conflict (ristorante_id, anno, mese, anno_doc, mese_doc, categoria, fornitore, fonte, user_id)
+    do update set
+        totale = c.totale + excluded.totale,
+        totale_positivo = c.totale_positivo + excluded.totale_positivo,
+        n_righe = c.n_righe + excluded.n_righe,
+        updated_at = now();
+
+    get diagnostics v_n = row_count;
+
+    if p_segno < 0 then
+        delete from public.costi_mensili_cubo c
+        using public.costi_cubo_celle(p_righe) d
+        where c.ristorante_id = d.ristorante_id
+          and c.anno = d.anno and c.mese = d.mese
+          and c.anno_doc = d.anno_doc and c.mese_doc = d.mese_doc
+          and c.categoria = d.categoria and c.fornitore = d.fornitore
+          and c.fonte = d.fonte and c.user_id = d.user_id
+          and c.n_righe <= 0;
+    end if;
+    return v_n;
+end;
+$$;
+
+revoke all on function public.costi_cubo_applica_righe(jsonb, integer) from public, anon, authenticated;
+
+
+-- ---------- Trigger per statement su fatture ----------
+-- Stesso schema di fn_prezzi_storico_da_fatture: ogni ramo legge solo le
+-- transition table del suo trigger. Sull'update contano solo le righe in cui
+-- cambia una colonna letta dal cubo (un needs_review non muove niente).
+create or replace function public.fn_costi_cubo_da_fatture()
+returns trigger
+language plpgsql
+security definer
+set search_path = public
+as $$
+declare
+    v_vecchie jsonb;
+    v_nuove jsonb;
+begin
+    if tg_op = 'INSERT' then
+        select jsonb_agg(to_jsonb(n)) into v_nuove from nuove n;
+    elsif tg_op = 'DELETE' then
+        select jsonb_agg(to_jsonb(o)) into v_vecchie from vecchie o;
+    else
+        select jsonb_agg(to_jsonb(o)), jsonb_agg(to_jsonb(n))
+          into v_vecchie, v_nuove
+        from vecchie o
+        join nuove n on n.id = o.id
+        where (o.ristorante_id, o.user_id, o.data_competenza, o.data_documento, o.categoria,
+               o.fornitore, o.totale_riga, o.ripartita_su_gruppo, o.deleted_at)
+              is distinct from
+              (n.ristorante_id, n.user_id, n.data_competenza, n.data_documento, n.categoria,
+               n.fornitore, n.totale_riga, n.ripartita_su_gruppo, n.deleted_at);
+    end if;
+
+    if v_vecchie is not null then
+        perform public.costi_cubo_applica_righe(v_vecchie, -1);
+    end if;
+    if v_nuove is not null then
+        perform public.costi_cubo_applica_righe(v_nuove, 1);
+    end if;
+    return null;
+end;
+$$;
+
+revoke all on function public.fn_costi_cubo_da_fatture() from public, anon, authenticated;
+
+drop trigger if exists trg_costi_cubo_ins on public.fatture;
+create trigger trg_costi_cubo_ins
+after insert on public.fatture
+referencing new table as nuove
+for each statement execute function public.fn_costi_cubo_da_fatture();
+
+drop trigger if exists trg_costi_cubo_upd on public.fatture;
+create trigger trg_costi_cubo_upd
+after update on public.fatture
+referencing old table as vecchie new table as nuove
+for each statement execute function public.fn_costi_cubo_da_fatture();
+
+drop trigger if exists trg_costi_cubo_del on public.fatture;
+create trigger trg_costi_cubo_del
+after delete on public.fatture
+referencing old table as vecchie
+for each statement execute function public.fn_costi_cubo_da_fatture();
+
+
+-- ---------- Quote dei costi di gruppo ----------
+-- Ricalcola da zero le celle 'quota' dei PV indicati: anno/mese del riparto
+-- (per entrambe le basi, come le righe proiettate di riparto_service), categoria
+-- della quota ('' per le quote legacy senza categoria), fornitore del riparto.
+create or replace function public.costi_cubo_ricalcola_quote(p_ristoranti uuid[])
+returns integer
+language plpgsql
+security definer
+set search_path = public
+as $$
+declare
+    v_n integer;
+begin
+    delete from public.costi_mensili_cubo c
+    where c.fonte = 'quota'
+      and c.ristorante_id = any(p_ristoranti);
+
+    insert into public.costi_mensili_cubo (
+        ristorante_id, user_id, anno, mese, anno_doc, mese_doc, categoria, fornitore, fonte,
+        totale, totale_positivo, n_righe, updated_at
+    )
+    select
+        q.ristorante_id, r.user_id, r.anno, r.mese, r.anno, r.mese,
+        coalesce(btrim(q.categoria), ''), coalesce(r.fornitore, ''), 'quota',
+        sum(q.quota_importo), sum(greatest(q.quota_importo, 0)), count(*)::integer, now()
+    from public.riparto_costi_catena_quote q
+    join public.riparto_costi_catena r on r.id = q.riparto_id
+    where q.ristorante_id = any(p_ristoranti)
+    group by q.ristorante_id, r.user_id, r.anno, r.mese,
+             coalesce(btrim(q.categoria), ''), coalesce(r.fornitore, '');
+
+    get diagnostics v_n = row_count;
+    return v_n;
+end;
+$$;
+
+revoke all on function public.costi_cubo_ricalcola_quote(uuid[]) from public, anon, authenticated;
+grant execute on function public.costi_cubo_ricalcola_quote(uuid[]) to service_role;
+
+create or replace function public.fn_costi_cubo_da_quote()
+returns trigger
+language plpgsql
+security definer
+set search_path = public
+as $$
+declare
+    v_ristoranti uuid[];
+begin
+    if tg_op = 'INSERT' then
+        select array_agg(distinct n.ristorante_id) into v_ristoranti from nuove n;
+    elsif tg_op = 'DELETE' then
+        select array_agg(distinct o.ristorante_id) into v_ristoranti from vecchie o;
+    else
+        select array_agg(distinct k.r) into v_ristoranti
+        from (select o.ristorante_id from vecchie o
+              union
+              select n.ristorante_id from nuove n) k(r);
+    end if;
+
+    if v_ristoranti is not null then
+        perform public.costi_cubo_ricalcola_quote(v_ristoranti);
+    end if;
+    return null;
+end;
+$$;
+
+revoke all on function public.fn_costi_cubo_da_quote() from public, anon, authenticated;
+
+drop trigger if exists trg_costi_cubo_quote_ins on public.riparto_costi_catena_quote;
+create trigger trg_costi_cubo_quote_ins
+after insert on public.riparto_costi_catena_quote
+referencing new table as nuove
+for each statement execute function public.fn_costi_cubo_da_quote();
+
+drop trigger if exists trg_costi_cubo_quote_upd on public.riparto_costi_catena_quote;
+create trigger trg_costi_cubo_quote_upd
+after update on public.riparto_costi_catena_quote
+referencing old table as vecchie new table as nuove
+for each statement execute function public.fn_costi_cubo_da_quote();
+
+-- Anche le cancellazioni a cascata dal riparto padre passano da qui.
+drop trigger if exists trg_costi_cubo_quote_del on public.riparto_costi_catena_quote;
+create trigger trg_costi_cubo_quote_del
+after delete on public.riparto_costi_catena_quote
+referencing old table as vecchie
+for each statement execute function public.fn_costi_cubo_da_quote();
+
+-- Il riparto padre porta mese e fornitore: cambiarli sposta le celle dei suoi PV.
+create or replace function public.fn_costi_cubo_da_riparto()
+returns trigger
+language plpgsql
+security definer
+set search_path = public
+as $$
+declare
+    v_ristoranti uuid[];
+begin
+    select array_agg(distinct q.ristorante_id) into v_ristoranti
+    from nuove n
+    join vecchie o on o.id = n.id
+    join public.riparto_costi_catena_quote q on q.riparto_id = n.id
+    where (o.user_id, o.anno, o.mese, o.fornitore)
+          is distinct from (n.user_id, n.anno, n.mese, n.fornitore);
+
+    if v_ristoranti is not null then
+        perform public.costi_cubo_ricalcola_quote(v_ristoranti);
+    end if;
+    return null;
+end;
+$$;
+
+revoke all on function public.fn_costi_cubo_da_riparto() from public, anon, authenticated;
+
+drop trigger if exists trg_costi_cubo_riparto_upd on public.riparto_costi_catena;
+create trigger trg_costi_cubo_riparto_upd
+after update on public.riparto_costi_catena
+referencing old table as vecchie new table as nuove
+for each statement execute function public.fn_costi_cubo_da_riparto();
+
+
+-- ---------- Lettura ----------
+-- Celle aggregate per (ristorante, anno, mese, categoria, fonte) sulla base
+-- scelta ('competenza' o 'documento'), in un solo jsonb. Anni NULL = nessun
+-- limite. p_user_id opzionale, come il filtro user_id delle vecchie RPC.
+create or replace function public.costi_cubo_mensili(
+    p_ristorante_ids uuid[],
+    p_anno_da integer default null,
+    p_anno_a integer default null,
+    p_base text default 'competenza',
+    p_user_id uuid default null
+)
+returns jsonb
+language sql
+stable
+security definer
+set search_path = public
+as $$
+    select coalesce(jsonb_agg(jsonb_build_object(
+               'ristorante_id', g.ristorante_id, 'anno', g.anno, 'mese', g.mese,
+               'categoria', g.categoria, 'fonte', g.fonte, 'totale', g.totale,
+               'totale_positivo', g.totale_positivo, 'n_righe', g.n_righe
+           ) order by g.ristorante_id, g.anno, g.mese, g.categoria, g.fonte), '[]'::jsonb)
+    from (
+        select c.ristorante_id, b.anno, b.mese, c.categoria, c.fonte,
+               sum(c.totale) as totale,
+               sum(c.totale_positivo) as totale_positivo,
+               sum(c.n_righe) as n_righe
+        from public.costi_mensili_cubo c
+        cross join lateral (
+            select case when p_base = 'documento' then c.anno_doc else c.anno end as anno,
+                   case when p_base = 'documento' then c.mese_doc else c.mese end as mese
+        ) b
+        where c.ristorante_id = any(p_ristorante_ids)
+          and (p_user_id is null or c.user_id = p_user_id)
+          and (p_anno_da is null or b.anno >= p_anno_da)
+          and (p_anno_a is null or b.anno <= p_anno_a)
+        group by c.ristorante_id, b.anno, b.mese, c.categoria, c.fonte
+    ) g;
+$$;
+
+revoke all on function public.costi_cubo_mensili(uuid[], integer, integer, text, uuid) from public, anon, authenticated;
+grant execute on function public.costi_cubo_mensili(uuid[], integer, integer, text, uuid) to service_role;
+
+
+-- ---------- Costi automatici del MOL dal cubo ----------
+-- Stesse firme e stesse regole di 20260805150000_costi_automatici_catchall_food:
+-- competenza, righe non ripartite, niente 'Da Classificare', FOOD catch-all
+-- (tutto tranne p_cat_spese e NOTE E DICITURE).
+-- Una differenza c'e': il cubo salva coalesce(categoria, ''), quindi NULL e ''
+-- finiscono nella stessa cella e qui restano fuori entrambe. Prima le righe NULL
+-- erano gia' scartate da `categoria <> ...`, ma quelle con categoria '' letterale
+-- passavano e contavano come FOOD. Ora non entrano nel MOL: sono righe senza
+-- categoria, come 'Da Classificare'. Stessa regola nei fallback sulle righe
+-- (margine_service.calcola_costi_automatici_per_anno,
+-- _calcola_costi_auto_per_periodo).
+CREATE OR REPLACE FUNCTION costi_automatici_mensili(
+    p_user_id uuid,
+    p_ristorante_id uuid,
+    p_anno int,
+    p_cat_food text[],
+    p_cat_spese text[]
+)
+RETURNS TABLE (mese int, food numeric, spese numeric)
+LANGUAGE sql
+STABLE
+SET search_path = public
+AS $$
+    SELECT
+        c.mese,
+        COALESCE(SUM(c.totale) FILTER (
+            WHERE c.categoria <> ALL(p_cat_spese) AND c.categoria <> '📝 NOTE E DICITURE'
+        ), 0) AS food,
+        COALESCE(SUM(c.totale) FILTER (WHERE c.categoria = ANY(p_cat_spese)), 0) AS spese
+    FROM costi_mensili_cubo c
+    WHERE c.user_id = p_user_id
+      AND c.ristorante_id = p_ristorante_id
+      AND c.anno = p_anno
+      AND c.mese BETWEEN 1 AND 12
+      AND c.fonte = 'fattura'                           -- anti-doppio-conteggio (MOL)
+      AND c.categoria NOT IN ('', 'Da Classificare')
+    GROUP BY c.mese
+    ORDER BY c.mese;
+$$;
+
+CREATE OR REPLACE FUNCTION costi_automatici_mensili_gruppo(
+    p_user_id uuid,
+    p_ristorante_ids uuid[],
+    p_anno int,
+    p_cat_food text[],
+    p_cat_spese text[]
+)
+RETURNS TABLE (ristorante_id uuid, mese int, food numeric, spese numeric)
+LANGUAGE sql
+STABLE
+SET search_path = public
+AS $$
+    SELECT
+        c.ristorante_id,
+        c.mese,
+        COALESCE(SUM(c.totale) FILTER (
+            WHERE c.categoria <> ALL(p_cat_spese) AND c.categoria <> '📝 NOTE E DICITURE'
+        ), 0) AS food,
+        COALESCE(SUM(c.totale) FILTER (WHERE c.categoria = ANY(p_cat_spese)), 0) AS spese
+    FROM costi_mensili_cubo c
+    WHERE c.user_id = p_user_id
+      AND c.ristorante_id = ANY(p_ristorante_ids)
+      AND c.anno = p_anno
+      AND c.mese BETWEEN 1 AND 12
+      AND c.fonte = 'fattura'                           -- anti-doppio-conteggio (MOL)
+      AND c.categoria NOT IN ('', 'Da Classificare')
+    GROUP BY c.ristorante_id, c.mese
+    ORDER BY c.ristorante_id, c.mese;
+$$;
+
+
+-- ---------- Rebuild ----------
+-- Ricalcola da zero le celle di un ristorante (o di tutti con NULL): righe
+-- fattura e quote. Ritorna le celle scritte.
+create or replace function public.costi_cubo_ricostruisci(p_ristorante_id uuid default null)
+returns integer
+language plpgsql
+security definer
+set search_path = public
+as $$
+declare
+    v_n integer;
+    v_ristoranti uuid[];
+begin
+    delete from public.costi_mensili_cubo c
+    where p_ristorante_id is null or c.ristorante_id = p_ristorante_id;
+
+    with righe as (
+        select
+            f.ristorante_id, f.user_id,
+            coalesce(f.data_competenza, f.data_documento) as data_comp,
+            f.data_documento as data_doc,
+            coalesce(f.categoria, '') as categoria,
+            coalesce(f.fornitore, '') as fornitore,
+            case when coalesce(f.ripartita_su_gruppo, false) then 'ripartita' else 'fattura' end as fonte,
+            coalesce(f.totale_riga, 0)::numeric as totale
+        from public.fatture f
+        where f.deleted_at is null
+          and f.ristorante_id is not null
+          and f.user_id is not null
+          and (p_ristorante_id is null or f.ristorante_id = p_ristorante_id)
+    )
+    insert into public.costi_mensili_cubo (
+        ristorante_id, user_id, anno, mese, anno_doc, mese_doc, categoria, fornitore, fonte,
+        totale, totale_positivo, n_righe, updated_at
+    )
+    select
+        ristorante_id, user_id,
+        coalesce(extract(year from data_comp)::integer, 0),
+        coalesce(extract(month from data_comp)::integer, 0),
+        coalesce(extract(year from data_doc)::integer, 0),
+        coalesce(extract(month from data_doc)::integer, 0),
+        categoria, fornitore, fonte,
+        sum(totale), sum(greatest(totale, 0)), count(*)::integer, now()
+    from righe
+    group by 1, 2, 3, 4, 5, 6, 7, 8, 9;
+
+    get diagnostics v_n = row_count;
+
+    select array_agg(distinct q.ristorante_id) into v_ristoranti
+    from public.riparto_costi_catena_quote q
+    where p_ristorante_id is null or q.ristorante_id = p_ristorante_id;
+
+    if v_ristoranti is not null then
+        v_n := v_n + public.costi_cubo_ricalcola_quote(v_ristoranti);
+    end if;
+    return v_n;
+end;
+$$;
+
+revoke all on function public.costi_cubo_ricostruisci(uuid) from public, anon, authenticated;
+grant execute on function public.costi_cubo_ricostruisci(uuid) to service_role;
+
+-- Popolamento iniziale: i lettori trattano la tabella come completa.
+select public.costi_cubo_ricostruisci();
@@ -0,0 +1,134 @@
+-- ═══════════════════════════════════════════════════════════════════════════════
+-- Migration: prezzi_storico_ricalcola sicura con scritture concorrenti su fatture
+-- ═══════════════════════════════════════════════════════════════════════════════
+-- BUG: il ricalcolo cancellava le chiavi e poi faceva un INSERT semplice. Due
+-- scritture concorrenti su fatture con la stessa (ristorante_id,
+-- descrizione_key, fornitore_key) cancellavano entrambe (nessuna vedeva la riga
+-- non ancora committata dell'altra) e poi inserivano entrambe: la seconda
+-- trovava la chiave primaria occupata. L'errore usciva dal trigger e annullava
+-- l'insert o l'update della fattura.
+--
+-- FIX: lock advisory di transazione per chiave (in ordine fisso) prima della
+-- delete, cosi' i ricalcoli della stessa coppia vanno in fila e il secondo
+-- vede le righe del primo. In piu' l'insert diventa ON CONFLICT DO UPDATE,
+-- come costi_mensili_cubo. Stessa firma, stessi grant.
+-- ═══════════════════════════════════════════════════════════════════════════════
+
+create or replace function public.prezzi_storico_ricalcola(
+    p_ristoranti uuid[],
+    p_descrizioni text[],
+    p_fornitori text[]
+)
+returns integer
+language plpgsql
+security definer
+set search_path = public
+as $$
+declare
+    v_n integer;
+begin
+    -- Una chiave alla volta: due scritture concorrenti su fatture che toccano
+    -- la stessa coppia si mettono in fila qui. Chi arriva secondo ricalcola
+    -- dopo il commit del primo, con un nuovo snapshot che ne vede le righe.
+    -- Ordine fisso delle chiavi per non incrociare i lock (deadlock).
+    perform pg_advisory_xact_lock(
+        hashtextextended('prezzi_storico:' || k.ristorante_id::text || '|' || k.descrizione_key || '|' || k.fornitore_key, 0)
+    )
+    from (
+        select distinct c.ristorante_id, c.descrizione_key, c.fornitore_key
+        from unnest(p_ristoranti, p_descrizioni, p_fornitori) as c(ristorante_id, descrizione_key, fornitore_key)
+        where c.ristorante_id is not null
+        order by 1, 2, 3
+    ) k;
+
+    delete from public.prezzi_storico s
+    using (
+        select distinct c.ristorante_id, c.descrizione_key, c.fornitore_key
+        from unnest(p_ristoranti, p_descrizioni, p_fornitori) as c(ristorante_id, descrizione_key, fornitore_key)
+    ) c
+    where s.ristorante_id = c.ristorante_id
+      and s.descrizione_key = c.descrizione_key
+      and s.fornitore_key = c.fornitore_key;
+
+    with chiavi as (
+        select distinct c.ristorante_id, c.descrizione_key, c.fornitore_key
+        from unnest(p_ristoranti, p_descrizioni, p_fornitori) as c(ristorante_id, descrizione_key, fornitore_key)
+        where c.ristorante_id is not null
+    ),
+    acquisti as (
+        select
+            c.ristorante_id, c.descrizione_key, c.fornitore_key,
+            f.user_id, f.descrizione, f.fornitore, f.categoria, f.file_origine,
+            f.prezzo_unitario::numeric as prezzo,
+            f.quantita::numeric as quantita,
+            f.data_documento as data,
+            -- 1 = ultimo acquisto. DESC mette le date nulle in testa, come il
+            -- sort pandas che le lascia in fondo all'ordine crescente.
+            row_number() over (
+                partition by c.ristorante_id, c.descrizione_key, c.fornitore_key
+                order by f.data_documento desc, f.id desc
+            ) as dalla_fine
+        from chiavi c
+        join public.fatture f
+          on f.ristorante_id = c.ristorante_id
+         and upper(btrim(coalesce(f.descrizione, ''))) = c.descrizione_key
+         and upper(btrim(coalesce(f.fornitore, ''))) = c.fornitore_key
+        where f.deleted_at is null
+          and f.prezzo_unitario > 0
+          and upper(coalesce(f.tipo_documento, '')) !~ 'TD04|NOTA DI CREDITO|NOTA CREDITO|\yNC\y|CREDIT'
+    )
+    insert into public.prezzi_storico (
+        ristorante_id, descrizione_key, fornitore_key, user_id, descrizione, fornitore,
+        categoria, n_acquisti, prezzo_medio, quantita_media, prima_data, ultima_data,
+        frequenza_mensile, ultimi_prezzi, ultime_date, ultime_quantita, ultimo_file, updated_at
+    )
+    select
+        ristorante_id, descrizione_key, fornitore_key,
+        (array_agg(user_id order by dalla_fine))[1],
+        -- mode(): a parita' di frequenza il primo nell'ordine, come prevalenti().
+        mode() within group (order by descrizione),
+        mode() within group (order by fornitore),
+        (array_agg(categoria order by dalla_fine))[1],
+        count(*)::integer,
+        avg(prezzo),
+        avg(quantita),
+        min(data),
+        max(data),
+        case
+            when count(data) >= 2
+            then count(data) / greatest(1.0, (max(data) - min(data)) / 30.0)
+            else 1.0
+        end,
+        array_agg(prezzo order by dalla_fine desc) filter (where dalla_fine <= 12),
+        array_agg(data order by dalla_fine desc) filter (where dalla_fine <= 12),
+        array_agg(quantita order by dalla_fine desc) filter (where dalla_fine <= 12),
+        (array_agg(file_origine order by dalla_fine))[1],
+        now()
+    from acquisti
+    group by ristorante_id, descrizione_key, fornitore_key
+    -- Rete di sicurezza oltre al lock: la chiave primaria non deve mai far
+    -- fallire il trigger, e con lui il salvataggio della fattura.
+    on conflict (ristorante_id, descrizione_key, fornitore_key) do update set
+        user_id = excluded.user_id,
+        descrizione = excluded.descrizione,
+        fornitore = excluded.fornitore,
+        categoria = excluded.categoria,
+        n_acquisti = excluded.n_acquisti,
+        prezzo_medio = excluded.prezzo_medio,
+        quantita_media = excluded.quantita_media,
+        prima_data = excluded.prima_data,
+        ultima_data = excluded.ultima_data,
+        frequenza_mensile = excluded.frequenza_mensile,
+        ultimi_prezzi = excluded.ultimi_prezzi,
+        ultime_date = excluded.ultime_date,
+        ultime_quantita = excluded.ultime_quantita,
+        ultimo_file = excluded.ultimo_file,
+        updated_at = excluded.updated_at;
+
+    get diagnostics v_n = row_count;
+    return v_n;
+end;
+$$;
+
+revoke all on function public.prezzi_storico_ricalcola(uuid[], text[], text[]) from public, anon, authenticated;
+grant execute on function public.prezzi_storico_ricalcola(uuid[], text[], text[]) to service_role;
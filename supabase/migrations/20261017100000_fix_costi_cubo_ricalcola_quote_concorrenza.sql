@@ -0,0 +1,69 @@
+-- ═══════════════════════════════════════════════════════════════════════════════
+-- Migration: costi_cubo_ricalcola_quote sicura con riparti concorrenti
+-- ═══════════════════════════════════════════════════════════════════════════════
+-- BUG: il ricalcolo delle celle 'quota' di un PV cancellava le celle e poi
+-- faceva un INSERT semplice. Due salvataggi di riparto sulla stessa catena
+-- (crea_riparto_con_quote, sostituisci_quote_riparto), anche di mesi diversi,
+-- ricalcolano le quote degli stessi PV. In READ COMMITTED il secondo insert
+-- trovava le celle appena committate dal primo e violava la chiave primaria
+-- del cubo: l'errore usciva dal trigger e annullava il salvataggio del riparto.
+-- Stesso difetto corretto per prezzi_storico in
+-- 20261010100000_fix_prezzi_storico_ricalcola_concorrenza.
+--
+-- FIX: lock advisory di transazione per PV (in ordine fisso) prima della
+-- delete, cosi' i ricalcoli dello stesso PV vanno in fila e il secondo vede le
+-- celle del primo. In piu' l'insert diventa ON CONFLICT DO UPDATE sulla
+-- chiave primaria. Stessa firma, stessi grant.
+-- ═══════════════════════════════════════════════════════════════════════════════
+
+create or replace function public.costi_cubo_ricalcola_quote(p_ristoranti uuid[])
+returns integer
+language plpgsql
+security definer
+set search_path = public
+as $$
+declare
+    v_n integer;
+begin
+    -- Un PV alla volta, in ordine fisso per non incrociare i lock (deadlock).
+    perform pg_advisory_xact_lock(hashtextextended('costi_cubo_quote:' || k.id::text, 0))
+    from (
+        select distinct r.id
+        from unnest(p_ristoranti) as r(id)
+        where r.id is not null
+        order by r.id
+    ) k;
+
+    delete from public.costi_mensili_cubo c
+    where c.fonte = 'quota'
+      and c.ristorante_id = any(p_ristoranti);
+
+    insert into public.costi_mensili_cubo (
+        ristorante_id, user_id, anno, mese, anno_doc, mese_doc, categoria, fornitore, fonte,
+        totale, totale_positivo, n_righe, updated_at
+    )
+    select
+        q.ristorante_id, r.user_id, r.anno, r.mese, r.anno, r.mese,
+        coalesce(btrim(q.categoria), ''), coalesce(r.fornitore, ''), 'quota',
+        sum(q.quota_importo), sum(greatest(q.quota_importo, 0)), count(*)::integer, now()
+    from public.riparto_costi_catena_quote q
+    join public.riparto_costi_catena r on r.id = q.riparto_id
+    where q.ristorante_id = any(p_ristoranti)
+    group by q.ristorante_id, r.user_id, r.anno, r.mese,
+             coalesce(btrim(q.categoria), ''), coalesce(r.fornitore, '')
+    -- Rete di sicurezza oltre al lock: la chiave primaria non deve mai far
+    -- fallire il trigger, e con lui il salvataggio del riparto.
+    on conflict (ristorante_id, anno, mese, anno_doc, mese_doc, categoria, fornitore, fonte, user_id)
+    do update set
+        totale = excluded.totale,
+        totale_positivo = excluded.totale_positivo,
+        n_righe = excluded.n_righe,
+        updated_at = excluded.updated_at;
+
+    get diagnostics v_n = row_count;
+    return v_n;
+end;
+$$;
+
+revoke all on function public.costi_cubo_ricalcola_quote(uuid[]) from public, anon, authenticated;
+grant execute on function public.costi_cubo_ricalcola_quote(uuid[]) to service_role;
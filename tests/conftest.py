@@ -51,9 +51,11 @@ CACHE_WORKER = (
     "_HOME_KPI_CACHE",
     "_DASHBOARD_STATS_CACHE",
     "_FATTURE_ROWS_CACHE",
+    "_RISTORANTE_QUOTE_CACHE",
 )
 CACHE_AUTH = ("_SESSIONE_CACHE",)
 CACHE_ADMIN = ("_ADMIN_CACHE",)
+CACHE_GRUPPO = ("_GRUPPO_SNAPSHOT_CACHE",)
 
 # `services/ai_service.py` non segue la convenzione MAIUSCOLO_CACHE: usa
 # `_memoria_cache` (minuscolo), che contiene la memoria di categorizzazione
@@ -99,6 +101,12 @@ def _reset_worker_caches():
         _reset(getattr(_admin, "_ADMIN_CACHE", None))
     except Exception:
         pass
+    try:
+        import services.routers.gruppo as _gruppo
+        for _name in CACHE_GRUPPO:
+            _reset(getattr(_gruppo, _name, None))
+    except Exception:
+        pass
     try:
         import services.auth_service as _auth
         for _name in CACHE_AUTH:
@@ -110,4 +118,29 @@ def _reset_worker_caches():
         _ai.invalida_cache_memoria()
     except Exception:
         pass
+    try:
+        import services.dedup_contenuto as _dedup
+        _dedup.svuota_cache()
+    except Exception:
+        pass
+    try:
+        import services.ai_quota as _quota
+        _quota.reset()
+    except Exception:
+        pass
+    try:
+        import services.session_token as _session_token
+        _session_token.reset()
+    except Exception:
+        pass
+    try:
+        import services.routers.prezzi as _prezzi
+        _prezzi._invalidate_prezzi_rows_cache()
+    except Exception:
+        pass
+    try:
+        import services.cache_bus as _cache_bus
+        _cache_bus.reset()
+    except Exception:
+        pass
     yield
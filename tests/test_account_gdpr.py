@@ -96,6 +96,20 @@ def test_elimina_cliente_ok_cancella_users():
     assert "users" in sb.deleted_tables  # la cancellazione di users propaga in cascade
 
 
+def test_elimina_revoca_le_sessioni_prima_della_delete():
+    """La cascata su `sessioni` cancellerebbe le righe senza che le revoche dei
+    token di accesso arrivino agli altri processi: si revoca prima."""
+    sb = FakeSB()
+    ordine = []
+    with _patch({"id": "u1", "email": "cliente@x.it"}, sb), \
+         patch.object(account, "_is_admin_email", return_value=False), \
+         patch("services.session_service.revoca_tutte_sessioni",
+               side_effect=lambda uid, _sb: ordine.append(("revoca", uid, list(sb.deleted_tables)))):
+        account.account_elimina(account.EliminaAccountBody(conferma="ELIMINA"), authorization="Bearer t")
+    assert ordine and ordine[0][:2] == ("revoca", "u1")
+    assert "users" not in ordine[0][2] and "users" in sb.deleted_tables
+
+
 def test_elimina_conferma_case_insensitive():
     """'elimina' minuscolo va accettato (upper() lato server)."""
     sb = FakeSB()
@@ -0,0 +1,234 @@
+"""Job batch notturni di classificazione AI (services/ai_batch_notturno).
+
+Fake Supabase in memoria per `ai_batch_job` e per la RPC
+`applica_suggerimenti_ai_bulk`; finto client OpenAI che risponde per idx a
+chat.completions (runner locale) e a files/batches (Batch API).
+"""
+import json
+import re
+from types import SimpleNamespace
+
+import pytest
+
+from services import ai_batch_notturno as abn
+from services import gpt_dispatcher
+
+_RE_IDX = re.compile(r'\{"idx":\s*(\d+),\s*"articolo"')
+
+
+class _Query:
+    def __init__(self, db, nome):
+        self.db, self.nome, self.filtri, self.op, self.valori = db, nome, [], "select", None
+
+    def select(self, *_a, **_k):
+        return self
+
+    def insert(self, riga):
+        self.op, self.valori = "insert", dict(riga)
+        return self
+
+    def update(self, campi):
+        self.op, self.valori = "update", dict(campi)
+        return self
+
+    def in_(self, campo, valori):
+        self.filtri.append(lambda r: r.get(campo) in valori)
+        return self
+
+    def eq(self, campo, valore):
+        self.filtri.append(lambda r: r.get(campo) == valore)
+        return self
+
+    def order(self, *_a, **_k):
+        return self
+
+    def limit(self, _n):
+        return self
+
+    def execute(self):
+        righe = self.db.setdefault(self.nome, [])
+        if self.op == "insert":
+            righe.append(json.loads(json.dumps(self.valori)))
+            return SimpleNamespace(data=[self.valori])
+        trovate = [r for r in righe if all(f(r) for f in self.filtri)]
+        if self.op == "update":
+            for r in trovate:
+                r.update(json.loads(json.dumps(self.valori)))
+        return SimpleNamespace(data=[dict(r) for r in trovate])
+
+
+class _Sb:
+    def __init__(self):
+        self.db = {}
+        self.rpc_chiamate = []
+
+    def table(self, nome):
+        return _Query(self.db, nome)
+
+    def rpc(self, nome, params):
+        self.rpc_chiamate.append((nome, params))
+        return SimpleNamespace(execute=lambda: SimpleNamespace(data=len(params["p_voci"])))
+
+    def job(self):
+        (j,) = self.db["ai_batch_job"]
+        return j
+
+
+def _risposta_chat(prompt: str) -> str:
+    idx = [int(i) for i in _RE_IDX.findall(prompt)]
+    return json.dumps({"risultati": [{"idx": i, "categoria": "CARNE", "confidence": "alta"} for i in idx]})
+
+
+class _Chat:
+    def __init__(self, rompi_dopo=None):
+        self.chiamate = 0
+        self.rompi_dopo = rompi_dopo
+
+    def create(self, **body):
+        if self.rompi_dopo is not None and self.chiamate >= self.rompi_dopo:
+            raise KeyboardInterrupt("riavvio del worker")
+        self.chiamate += 1
+        return SimpleNamespace(
+            choices=[SimpleNamespace(message=SimpleNamespace(content=_risposta_chat(body["messages"][0]["content"])))],
+            usage=SimpleNamespace(prompt_tokens=100, completion_tokens=20),
+        )
+
+
+@pytest.fixture(autouse=True)
+def _ambiente(monkeypatch):
+    gpt_dispatcher.reset()
+    monkeypatch.setenv("ONEFLUX_AI_BATCH_MAX", "2")
+    yield
+    gpt_dispatcher.reset()
+
+
+_DESCS = ["PETTO POLLO", "COSCE POLLO", "SALSICCIA", "HAMBURGER", "ARROSTO"]
+
+
+def test_runner_locale_applica_in_bulk_una_rpc_per_blocco():
+    sb = _Sb()
+    chat = _Chat()
+    client = SimpleNamespace(chat=SimpleNamespace(completions=chat))
+    res = abn.esegui_job(sb, _DESCS, ["F"] * 5, runner=abn.RunnerLocale(client, dormi=lambda _s: None))
+
+    assert res["suggerite"] == 5 and res["errori"] == 0 and res["stato"] == "applicato"
+    assert chat.chiamate == 3, "batch da 2: 2+2+1"
+    (nome, params), = sb.rpc_chiamate
+    assert nome == "applica_suggerimenti_ai_bulk"
+    assert [v["descrizione"] for v in params["p_voci"]] == _DESCS
+    assert {v["categoria_suggerita"] for v in params["p_voci"]} == {"CARNE"}
+    job = sb.job()
+    assert job["stato"] == "applicato" and len(job["applicati"]) == 3
+
+
+def test_riavvio_riprende_dal_checkpoint(monkeypatch):
+    monkeypatch.setattr(abn, "_BLOCCO_APPLICA", 1)
+    sb = _Sb()
+    primo = _Chat(rompi_dopo=1)
+    with pytest.raises(KeyboardInterrupt):
+        abn.esegui_job(sb, _DESCS, ["F"] * 5,
+                       runner=abn.RunnerLocale(SimpleNamespace(chat=SimpleNamespace(completions=primo)),
+                                               dormi=lambda _s: None))
+    job = sb.job()
+    assert job["stato"] == "inviato" and len(job["applicati"]) == 1
+
+    secondo = _Chat()
+    res = abn.esegui_job(sb, [], [],
+                         runner=abn.RunnerLocale(SimpleNamespace(chat=SimpleNamespace(completions=secondo)),
+                                                 dormi=lambda _s: None))
+    assert secondo.chiamate == 2, "il batch gia' applicato non si ripaga"
+    assert res["stato"] == "applicato" and res["suggerite"] == 3
+    scritte = [v["descrizione"] for _n, p in sb.rpc_chiamate for v in p["p_voci"]]
+    assert scritte == _DESCS
+
+
+class _BatchApi:
+    def __init__(self):
+        self.stato = "in_progress"
+        self.input = None
+        self.files = SimpleNamespace(create=self._file_create, content=self._file_content)
+        self.batches = SimpleNamespace(create=self._batch_create, retrieve=self._batch_retrieve)
+
+    def _file_create(self, file, purpose):
+        assert purpose == "batch"
+        self.input = [json.loads(l) for l in file[1].read().decode("utf-8").splitlines()]
+        return SimpleNamespace(id="file-in")
+
+    def _batch_create(self, input_file_id, endpoint, completion_window, metadata):
+        assert (input_file_id, endpoint, completion_window) == ("file-in", "/v1/chat/completions", "24h")
+        return SimpleNamespace(id="batch-1")
+
+    def _batch_retrieve(self, _id):
+        return SimpleNamespace(status=self.stato, output_file_id="file-out" if self.stato == "completed" else None)
+
+    def _file_content(self, _id):
+        righe = []
+        for r in self.input:
+            if r["custom_id"].endswith(":1"):
+                righe.append({"custom_id": r["custom_id"], "response": None, "error": {"message": "boom"}})
+                continue
+            righe.append({"custom_id": r["custom_id"], "error": None, "response": {"status_code": 200, "body": {
+                "choices": [{"message": {"content": _risposta_chat(r["body"]["messages"][0]["content"])}}],
+                "usage": {"prompt_tokens": 50, "completion_tokens": 10},
+            }}})
+        return SimpleNamespace(text="\n".join(json.dumps(r) for r in righe))
+
+
+def test_runner_openai_poll_e_ripresa_al_giro_dopo():
+    sb = _Sb()
+    api = _BatchApi()
+    res = abn.esegui_job(sb, _DESCS, ["F"] * 5, runner=abn.RunnerOpenAI(api), attesa_max_s=0)
+    assert res["stato"] == "inviato" and sb.rpc_chiamate == []
+    riga = api.input[0]
+    assert riga["method"] == "POST" and riga["url"] == "/v1/chat/completions"
+    assert riga["body"]["response_format"] == {"type": "json_object"}
+    assert sb.job()["id_remoto"] == "batch-1"
+
+    api.stato = "completed"
+    res = abn.esegui_job(sb, [], [], runner=abn.RunnerOpenAI(api), attesa_max_s=0)
+    assert res["stato"] == "applicato"
+    assert res["suggerite"] == 3 and res["errori"] == 2, "il batch :1 in errore non blocca gli altri"
+    assert sb.job()["stato"] == "applicato"
+
+
+def test_batch_remoto_fallito():
+    sb = _Sb()
+    api = _BatchApi()
+    api.stato = "expired"
+    res = abn.esegui_job(sb, _DESCS, ["F"] * 5, runner=abn.RunnerOpenAI(api), attesa_max_s=0)
+    assert res["stato"] == "fallito" and res["errori"] == 5
+    assert sb.job()["stato"] == "fallito"
+
+
+def test_regole_forti_correggono_le_risposte_del_batch(monkeypatch):
+    """Stessa post-elaborazione del percorso sincrono: GPT risponde BEVANDE a
+    tutto, le regole forti rimettono a posto salmone e acqua."""
+    descs = ["SALMONI NORVEGESI (BRAVO)", "ACQUA MINERALE NATURALE"]
+
+    def _bevande(prompt):
+        idx = [int(i) for i in _RE_IDX.findall(prompt)]
+        return json.dumps({"risultati": [{"idx": i, "categoria": "BEVANDE", "confidence": "alta"} for i in idx]})
+
+    monkeypatch.setitem(globals(), "_risposta_chat", _bevande)
+    sb = _Sb()
+    client = SimpleNamespace(chat=SimpleNamespace(completions=_Chat()))
+    res = abn.esegui_job(sb, descs, ["F"] * 2, runner=abn.RunnerLocale(client, dormi=lambda _s: None))
+
+    assert res["stato"] == "applicato"
+    voci = {v["descrizione"]: v["categoria_suggerita"] for _n, p in sb.rpc_chiamate for v in p["p_voci"]}
+    assert voci == {"SALMONI NORVEGESI (BRAVO)": "PESCE", "ACQUA MINERALE NATURALE": "ACQUA"}
+
+
+def test_job_dell_altro_runner_scade_e_non_blocca_i_giri():
+    sb = _Sb()
+    sb.db["ai_batch_job"] = [{
+        "id": "vecchio", "stato": "inviato", "runner": "openai", "richieste": [], "applicati": [],
+        "id_remoto": "batch_x", "created_at": "2026-01-01T00:00:00+00:00",
+        "updated_at": "2026-01-01T00:00:00+00:00",
+    }]
+    client = SimpleNamespace(chat=SimpleNamespace(completions=_Chat()))
+    res = abn.esegui_job(sb, _DESCS, ["F"] * 5, runner=abn.RunnerLocale(client, dormi=lambda _s: None))
+
+    vecchio, nuovo = sb.db["ai_batch_job"]
+    assert vecchio["stato"] == "fallito" and vecchio["errore"].startswith("scaduto")
+    assert res["stato"] == "applicato" and res["job"] == nuovo["id"] and res["suggerite"] == 5
@@ -0,0 +1,121 @@
+"""Quote AI giornaliere con prenotazione atomica (services/ai_quota).
+
+Il fake della RPC `ai_quota_riserva` riproduce il compare-and-increment in
+memoria (con lock, come la riga bloccata dall'UPDATE) e conta le chiamate:
+le prenotazioni coperte dal lotto locale non devono fare I/O.
+"""
+import threading
+from types import SimpleNamespace
+from unittest.mock import MagicMock
+
+import pytest
+
+import services
+import services.ai_service as ai
+from services import ai_quota, worker_metrics
+
+
+class _Db:
+    def __init__(self, seed=0):
+        self.usati = {}
+        self.seed = seed
+        self.chiamate = 0
+        self.lock = threading.Lock()
+
+    def rpc(self, nome, params):
+        assert nome == "ai_quota_riserva"
+
+        def _execute():
+            with self.lock:
+                self.chiamate += 1
+                chiave = (params["p_ristorante_id"], params["p_famiglia"])
+                usati = self.usati.setdefault(chiave, self.seed)
+                limite = params["p_limite"]
+                if limite is None or usati + params["p_n"] <= limite:
+                    self.usati[chiave] = usati + params["p_n"]
+                    return SimpleNamespace(data=[{"concessa": True, "usati": self.usati[chiave]}])
+                return SimpleNamespace(data=[{"concessa": False, "usati": usati}])
+
+        return SimpleNamespace(execute=_execute)
+
+
+@pytest.fixture
+def db(monkeypatch):
+    fake = _Db()
+    monkeypatch.setattr(services, "get_supabase_client", lambda: fake)
+    return fake
+
+
+def test_lotto_locale_evita_il_round_trip(db):
+    for _ in range(10):
+        assert ai_quota.riserva("r1", "categorization", 1, limite=1000).concessa
+    assert db.chiamate == 1, "un lotto da 10 (1% di 1000) copre dieci prenotazioni"
+    assert db.usati[("r1", "categorization")] == 10
+    ai_quota.riserva("r1", "categorization", 1, limite=1000)
+    assert db.chiamate == 2
+
+
+def test_concorrenza_non_sfora_il_limite(db):
+    concesse = []
+
+    def _upload():
+        for _ in range(20):
+            p = ai_quota.riserva("r1", "vision", 1, limite=50)
+            concesse.append(p.concessa)
+
+    threads = [threading.Thread(target=_upload) for _ in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert sum(concesse) == 50
+    assert db.usati[("r1", "vision")] == 50
+
+
+def test_lotto_ridotto_vicino_al_limite_e_rifiuto(db):
+    db.seed = 995
+    assert ai_quota.riserva("r1", "categorization", 3, limite=1000).concessa, "il lotto da 10 non ci sta: basta 3"
+    negata = ai_quota.riserva("r1", "categorization", 5, limite=1000)
+    assert not negata.concessa and negata.usati == 998
+    snap = worker_metrics.snapshot()["ai_quota"]
+    assert snap[0]["rifiutate"] == 1 and snap[0]["concesse"] == 1
+
+
+def test_conferma_restituisce_e_integra(db):
+    p = ai_quota.riserva("r1", "categorization", 10, limite=1000)
+    ai_quota.conferma(p, 4)
+    assert ai_quota.riserva("r1", "categorization", 6, limite=1000).concessa
+    assert db.chiamate == 1, "le 6 non usate sono tornate al lotto"
+
+    p = ai_quota.riserva("r1", "categorization", 10, limite=1000)
+    ai_quota.conferma(p, 13)
+    assert db.usati[("r1", "categorization")] == 23, "i retry oltre la prenotazione si integrano a DB"
+
+
+def test_rpc_assente_ripiega_sul_conteggio(monkeypatch):
+    monkeypatch.setattr(services, "get_supabase_client", lambda: MagicMock())
+    monkeypatch.setattr("services.ai_cost_service.get_daily_quota_status",
+                        lambda **kw: {"used": 50, "limit": 50, "remaining": 0, "is_exceeded": True})
+    p = ai_quota.riserva("r1", "vision", 1, limite=50)
+    assert not p.concessa and p.usati == 50
+    assert ai_quota.stato()[0]["ripieghi_conteggio"] == 1
+
+
+def test_classifica_con_ai_prenota_e_conferma_le_chiamate_fatte(db, monkeypatch):
+    monkeypatch.setattr("services.ai_risposte_cache.leggi_risposte", lambda _c: {})
+    monkeypatch.setattr(ai.st, "session_state", {})  # niente bypass admin
+
+    def _finto_gpt(descs, _client, **_kw):
+        ai._ai_ctx_chiamate_gpt.get().append(1)
+        return ["CARNE"] * len(descs), ["alta"] * len(descs)
+
+    monkeypatch.setattr(ai, "_chiama_gpt_classificazione", _finto_gpt)
+    ai.classifica_con_ai(["PETTO POLLO"], openai_client=MagicMock(), ristorante_id="r1")
+    assert db.usati[("r1", "categorization")] == 10
+    assert ai_quota.stato()[0]["consumati_processo"] == 1
+
+    db.usati[("r1", "categorization")] = 1000
+    ai_quota.reset()
+    with pytest.raises(ai.AIDailyLimitExceededError) as exc:
+        ai.classifica_con_ai(["PETTO POLLO"], openai_client=MagicMock(), ristorante_id="r1")
+    assert exc.value.used == 1000
@@ -0,0 +1,155 @@
+"""Cache condivisa delle risposte GPT di categorizzazione (services/ai_risposte_cache).
+
+Il fake Supabase tiene `ai_risposte_cache` in memoria. `_chiama_gpt_classificazione`
+e' decorata con il `retry` mockato dal conftest: per la scrittura si usa la
+funzione vera recuperata dal mock (come in test_ai_service_troncamento), per la
+lettura in classifica_con_ai la si sostituisce con un finto che registra cosa
+viene davvero inviato a GPT.
+"""
+import json
+from types import SimpleNamespace
+from unittest.mock import MagicMock
+
+import pytest
+
+import services.ai_service as ai
+from services import ai_risposte_cache as arc
+
+
+class _Query:
+    def __init__(self, db):
+        self.db, self.filtri = db, []
+
+    def select(self, *_a, **_k):
+        return self
+
+    def in_(self, campo, valori):
+        self.filtri.append(lambda r: r.get(campo) in set(valori))
+        return self
+
+    def gte(self, campo, valore):
+        self.filtri.append(lambda r: r.get(campo) >= valore)
+        return self
+
+    def upsert(self, righe, on_conflict=""):
+        for r in righe:
+            self.db[r[on_conflict]] = dict(r)
+        return self
+
+    def execute(self):
+        return SimpleNamespace(data=[r for r in self.db.values() if all(f(r) for f in self.filtri)])
+
+
+@pytest.fixture
+def db(monkeypatch):
+    righe = {}
+    monkeypatch.setattr(arc, "_client", lambda: SimpleNamespace(table=lambda _n: _Query(righe)))
+    monkeypatch.delenv("ONEFLUX_AI_CACHE_TTL_GIORNI", raising=False)
+    return righe
+
+
+@pytest.fixture
+def tracciati(monkeypatch):
+    eventi = []
+    monkeypatch.setattr("services.ai_cost_service.track_ai_usage", lambda **kw: eventi.append(kw))
+    return eventi
+
+
+def test_chiave():
+    base = arc.chiave_risposta("MOZZARELLA  fdl", "Grossista Spa", 4, None, "gpt-4.1-mini")
+    assert arc.chiave_risposta(" mozzarella FDL ", "GROSSISTA SPA", "4.00", "", "gpt-4.1-mini") == base
+    for variante in (
+        arc.chiave_risposta("MOZZARELLA FDL", "ALTRO", 4, None, "gpt-4.1-mini"),
+        arc.chiave_risposta("MOZZARELLA FDL", "GROSSISTA SPA", 10, None, "gpt-4.1-mini"),
+        arc.chiave_risposta("MOZZARELLA FDL", "GROSSISTA SPA", 4, "LATTICINI", "gpt-4.1-mini"),
+        arc.chiave_risposta("MOZZARELLA FDL", "GROSSISTA SPA", 4, None, "gpt-4o-mini"),
+    ):
+        assert variante != base
+
+
+def test_cambio_prompt_invalida(monkeypatch):
+    base = arc.chiave_risposta("MOZZARELLA", None, None, None, "m")
+    arc.versione_prompt.cache_clear()
+    monkeypatch.setattr("config.prompt_ai_potenziato.PROMPT_CLASSIFICAZIONE_AI", "prompt nuovo {ARTICOLI}")
+    try:
+        assert arc.chiave_risposta("MOZZARELLA", None, None, None, "m") != base
+    finally:
+        arc.versione_prompt.cache_clear()
+
+
+def _chiama_gpt_vera():
+    import tenacity
+
+    for c in tenacity.retry.return_value.call_args_list:
+        f = c.args[0] if c.args else None
+        if getattr(f, "__name__", None) == "_chiama_gpt_classificazione":
+            return f
+    pytest.fail("impossibile recuperare _chiama_gpt_classificazione non decorata")
+
+
+def test_chiamata_gpt_memorizza_solo_categorie_valide(db, tracciati):
+    categorie = [
+        {"idx": 0, "categoria": "LATTICINI", "confidence": "alta"},
+        {"idx": 1, "categoria": "Da Classificare"},
+        {"idx": 2, "categoria": "CATEGORIA INVENTATA"},
+    ]
+    resp = SimpleNamespace(
+        choices=[SimpleNamespace(message=SimpleNamespace(content=json.dumps({"risultati": categorie})),
+                                 finish_reason="stop")],
+        usage=SimpleNamespace(prompt_tokens=600, completion_tokens=300),
+    )
+    client = MagicMock()
+    client.chat.completions.create.return_value = resp
+    _chiama_gpt_vera()(["MOZZARELLA FDL", "XYZ 123", "ABC 456"], client,
+                       lista_fornitori=["GROSSISTA SPA", "", ""], lista_iva=[4, 22, 22])
+
+    (voce,) = db.values()
+    chiave = arc.chiave_risposta(ai._descrizione_per_gpt("MOZZARELLA FDL"), "GROSSISTA SPA", 4, None,
+                                 ai._modello_classificazione())
+    assert voce["chiave"] == chiave
+    assert (voce["categoria"], voce["confidenza"], voce["token_stimati"]) == ("LATTICINI", "alta", 300)
+    assert voce["versione_prompt"] == arc.versione_prompt()
+
+
+def test_classifica_con_ai_salta_gpt_per_le_risposte_note(db, tracciati, monkeypatch):
+    modello = ai._modello_classificazione()
+    arc.salva_risposte([{
+        "chiave": arc.chiave_risposta(ai._descrizione_per_gpt("MOZZARELLA FDL"), "GROSSISTA SPA", 4, None, modello),
+        "categoria": "LATTICINI", "confidenza": "alta", "token_stimati": 250,
+    }], modello)
+
+    inviati = []
+
+    def _finto_gpt(descs, _client, **_kw):
+        inviati.append(list(descs))
+        return ["CARNE"] * len(descs), ["media"] * len(descs)
+
+    monkeypatch.setattr(ai, "_chiama_gpt_classificazione", _finto_gpt)
+    cats = ai.classifica_con_ai(
+        ["MOZZARELLA FDL", "PETTO POLLO"], lista_fornitori=["GROSSISTA SPA", "GROSSISTA SPA"],
+        lista_iva=[4, 10], openai_client=MagicMock(), ristorante_id=None,
+    )
+    assert cats == ["LATTICINI", "CARNE"]
+    assert inviati == [["PETTO POLLO"]], "solo il miss va a GPT"
+
+    (evento,) = tracciati
+    assert evento["operation_type"] == "categorization_cache"
+    assert evento["metadata"]["cache_hit"] == 1 and evento["metadata"]["cache_miss"] == 1
+    assert evento["metadata"]["token_risparmiati"] == 250
+
+    # Stessa riga da un altro fornitore: chiave diversa, va a GPT.
+    inviati.clear()
+    ai.classifica_con_ai(["MOZZARELLA FDL"], lista_fornitori=["ALTRO"], lista_iva=[4],
+                         openai_client=MagicMock())
+    assert inviati == [["MOZZARELLA FDL"]]
+
+
+def test_ttl_zero_spegne_la_cache(db, monkeypatch):
+    monkeypatch.setenv("ONEFLUX_AI_CACHE_TTL_GIORNI", "0")
+    arc.salva_risposte([{"chiave": "k", "categoria": "CARNE", "confidenza": "alta", "token_stimati": 1}], "m")
+    assert db == {}
+    monkeypatch.setenv("ONEFLUX_AI_CACHE_TTL_GIORNI", "30")
+    arc.salva_risposte([{"chiave": "k", "categoria": "CARNE", "confidenza": "alta", "token_stimati": 1}], "m")
+    assert arc.leggi_risposte(["k"]) == {"k": ("CARNE", "alta", 1)}
+    db["k"]["updated_at"] = "2000-01-01T00:00:00+00:00"
+    assert arc.leggi_risposte(["k"]) == {}, "voce scaduta"
@@ -22,7 +22,7 @@ class _AttrDict(dict):
 def _build_query_mock(data=None, execute_side_effect=None):
     query = MagicMock()
     for method in [
-        "select", "eq", "neq", "gte", "lte", "lt", "is_",
+        "select", "eq", "neq", "gt", "gte", "lte", "lt", "is_",
         "range", "insert", "update", "upsert", "order", "delete", "or_", "in_", "limit"
     ]:
         getattr(query, method).return_value = query
@@ -93,8 +93,8 @@ class TestAiService:
         assert result == ["Da Classificare", "Da Classificare"]
 
     def test_fetch_all_rows_paginato(self):
-        page1 = [{"descrizione": f"Prod{i}", "categoria": "BEVANDE"} for i in range(1000)]
-        page2 = [{"descrizione": "Prod1000", "categoria": "BEVANDE"}]
+        page1 = [{"id": i, "descrizione": f"Prod{i}", "categoria": "BEVANDE"} for i in range(1000)]
+        page2 = [{"id": 1000, "descrizione": "Prod1000", "categoria": "BEVANDE"}]
 
         query = _build_query_mock(
             execute_side_effect=[
@@ -114,7 +114,10 @@ class TestAiService:
         )
 
         assert len(rows) == 1001
-        assert query.range.call_count == 2
+        # Keyset: la seconda pagina riparte dall'ultimo id, niente offset.
+        query.range.assert_not_called()
+        query.gt.assert_called_once_with("id", 999)
+        supabase.table.return_value.select.assert_called_with("descrizione, categoria, id")
 
     def test_carica_memoria_completa_con_client_iniettato(self):
         ai_mod.invalida_cache_memoria()
@@ -108,22 +108,24 @@ def test_costi_auto_escludono_fatture_ripartite():
     import services.fastapi_worker as fw
     import inspect
 
-    for fn in (fw._calcola_costi_auto_per_mese, fw._calcola_costi_auto_per_periodo):
-        src = inspect.getsource(fn)
-        assert '.neq("ripartita_su_gruppo", True)' in src, (
-            f"{fn.__name__} non filtra le fatture ripartite"
-        )
+    # _per_mese passa da _per_periodo; il cubo tiene le ripartite in una fonte a
+    # parte (test_costi_cubo), il ricalcolo dalle righe le filtra qui.
+    assert "_calcola_costi_auto_per_periodo(" in inspect.getsource(fw._calcola_costi_auto_per_mese)
+    src = inspect.getsource(fw._calcola_costi_auto_per_periodo)
+    assert '.neq("ripartita_su_gruppo", True)' in src, (
+        "_calcola_costi_auto_per_periodo non filtra le fatture ripartite"
+    )
 
 
 def test_costi_auto_escludono_entrambe_le_grafie_note():
     import services.fastapi_worker as fw
     import inspect
 
-    for fn in (fw._calcola_costi_auto_per_mese, fw._calcola_costi_auto_per_periodo):
-        src = inspect.getsource(fn)
-        assert "CATEGORIE_NOTE_WORKER" in src, (
-            f"{fn.__name__} confronta la sola stringa con emoji"
-        )
+    src = inspect.getsource(fw._calcola_costi_auto_per_periodo)
+    # Due volte: lettura dal cubo e ricalcolo dalle righe.
+    assert src.count("CATEGORIE_NOTE_WORKER") >= 2, (
+        "_calcola_costi_auto_per_periodo confronta la sola stringa con emoji"
+    )
 
 
 def test_costanti_spese_derivano_da_una_sola_fonte():
@@ -0,0 +1,161 @@
+"""Bus di invalidazione cache tra processi (services/cache_bus).
+
+Il fake di `cache_eventi` tiene gli eventi in una lista con id crescente e
+risponde solo alle query che il bus fa (insert, ultimo id, id > X): i test
+simulano un secondo processo scrivendo eventi con un'altra origine.
+"""
+from types import SimpleNamespace
+
+import pytest
+
+import services.ai_service as ai
+import services.fastapi_worker as fw
+from services import cache_bus
+from services.routers import prezzi
+
+
+class _Query:
+    def __init__(self, db):
+        self.db = db
+        self.righe_insert = None
+        self.dopo = None
+        self.desc = False
+        self.limite = None
+
+    def insert(self, righe):
+        self.righe_insert = righe
+        return self
+
+    def select(self, _cols):
+        return self
+
+    def gt(self, _col, valore):
+        self.dopo = valore
+        return self
+
+    def order(self, _col, desc=False):
+        self.desc = desc
+        return self
+
+    def limit(self, n):
+        self.limite = n
+        return self
+
+    def execute(self):
+        if self.db.guasto:
+            raise RuntimeError("db giu'")
+        if self.righe_insert is not None:
+            for r in self.righe_insert:
+                self.db.eventi.append({"id": len(self.db.eventi) + 1, **r})
+            return SimpleNamespace(data=self.righe_insert)
+        righe = [e for e in self.db.eventi if self.dopo is None or e["id"] > self.dopo]
+        righe.sort(key=lambda e: e["id"], reverse=self.desc)
+        return SimpleNamespace(data=righe[: self.limite])
+
+
+class _Db:
+    def __init__(self):
+        self.eventi = []
+        self.guasto = False
+
+    def table(self, nome):
+        assert nome == cache_bus.TABELLA
+        return _Query(self)
+
+    def da_altro_processo(self, dominio, ristorante_id=None):
+        self.eventi.append({
+            "id": len(self.eventi) + 1, "dominio": dominio,
+            "ristorante_id": ristorante_id, "origine": "altro-processo",
+        })
+
+
+@pytest.fixture
+def db(monkeypatch):
+    monkeypatch.setattr(cache_bus, "attivo", lambda: True)
+    return _Db()
+
+
+def test_pubblica_accoda_fonde_e_invia(db):
+    cache_bus.pubblica("fatture", "r1")
+    cache_bus.pubblica("fatture", "r1")
+    cache_bus.pubblica("home_kpi", "r1")
+    assert cache_bus.invia_pendenti(db) == 2
+    assert {(e["dominio"], e["origine"]) for e in db.eventi} == {
+        ("fatture", cache_bus.ORIGINE), ("home_kpi", cache_bus.ORIGINE),
+    }
+
+    db.guasto = True
+    cache_bus.pubblica("fatture", "r2")
+    assert cache_bus.invia_pendenti(db) == -1
+    assert cache_bus.stato()["pendenti"] == 1, "evento rimesso in coda"
+
+
+def test_senza_bus_avviato_non_pubblica(monkeypatch):
+    monkeypatch.setattr(cache_bus, "attivo", lambda: False)
+    cache_bus.pubblica("fatture", "r1")
+    assert cache_bus.stato()["pendenti"] == 0
+
+
+def test_eventi_altrui_svuotano_solo_il_ristorante(db, monkeypatch):
+    db.da_altro_processo("fatture", "r0")
+    assert cache_bus.sincronizza(db) == 0, "al primo giro si parte dall'ultimo id"
+
+    fw._FATTURE_ROWS_CACHE.set("r1::2026-01-01::2026-12-31", "righe r1")
+    fw._FATTURE_ROWS_CACHE.set("r2::2026-01-01::2026-12-31", "righe r2")
+    fw._DASHBOARD_STATS_CACHE.set("dashstats:u1:r1", {"n": 1})
+    prezzi._PREZZI_ROWS_CACHE.set("r1::2026-01-01::2026-12-31::", "righe")
+    prezzi._PREZZI_ROWS_CACHE.set("r2::2026-01-01::2026-12-31::", "righe")
+    fw._HOME_KPI_CACHE.set("r1:2026:5", "kpi")
+    monkeypatch.setattr(fw, "get_supabase_client", lambda: pytest.fail("niente briefing dal bus"))
+
+    db.da_altro_processo("fatture", "r1")
+    db.da_altro_processo("home_kpi", "r1")
+    db.eventi.append({"id": 4, "dominio": "fatture", "ristorante_id": "r2", "origine": cache_bus.ORIGINE})
+    assert cache_bus.sincronizza(db) == 3
+
+    assert list(fw._FATTURE_ROWS_CACHE.keys()) == ["r2::2026-01-01::2026-12-31"], "evento proprio saltato"
+    assert "dashstats:u1:r1" not in fw._DASHBOARD_STATS_CACHE
+    assert list(prezzi._PREZZI_ROWS_CACHE.keys()) == ["r2::2026-01-01::2026-12-31::"]
+    assert len(fw._HOME_KPI_CACHE) == 0
+    assert cache_bus.stato()["pendenti"] == 0, "un evento ricevuto non si ripubblica"
+    assert cache_bus.stato()["applicati"] == 2
+
+
+def test_invalidazione_locale_pubblica_l_evento(db, monkeypatch):
+    monkeypatch.setattr(fw, "get_supabase_client", lambda: SimpleNamespace(
+        table=lambda _n: pytest.fail("propaga=False non tocca il briefing")))
+    fw._invalidate_fatture_rows_cache("r1", propaga=False)
+    fw._invalidate_home_kpi_cache("r1", propaga=False)
+    assert cache_bus.stato()["pendenti"] == 0
+
+    fw._invalidate_home_kpi_cache("r1")
+    assert cache_bus.invia_pendenti(db) == 1
+    assert db.eventi[0]["dominio"] == "home_kpi" and db.eventi[0]["ristorante_id"] == "r1"
+
+
+def test_evento_memoria_anticipa_il_controllo_versione(db):
+    cache_bus.sincronizza(db)
+    ai._remote_version_state["last_checked_at"] = 1e12
+    db.da_altro_processo("memoria")
+    cache_bus.sincronizza(db)
+    assert ai._remote_version_state["last_checked_at"] == 0.0
+
+
+def test_evento_committato_fuori_ordine_non_si_perde(db):
+    applicati = []
+    cache_bus.registra("test_fuori_ordine", applicati.append)
+    cache_bus.sincronizza(db)
+
+    def evento(id_, rid):
+        db.eventi.append({"id": id_, "dominio": "test_fuori_ordine",
+                          "ristorante_id": rid, "origine": "altro-processo"})
+
+    # L'id 2 e' stato assegnato prima del 3 ma il suo commit arriva dopo.
+    evento(1, "r1")
+    evento(3, "r3")
+    assert cache_bus.sincronizza(db) == 2
+    evento(2, "r2")
+    assert cache_bus.sincronizza(db) == 1
+    assert cache_bus.sincronizza(db) == 0, "gli id gia' visti non si riapplicano"
+    assert applicati == ["r1", "r3", "r2"]
+    assert cache_bus.stato()["ultimo_id"] == 3
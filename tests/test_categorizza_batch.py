@@ -0,0 +1,111 @@
+"""categorizza_batch deve restituire ESATTAMENTE cio' che categorizza_con_memoria
+restituisce riga per riga (categoria + flag fallback), facendo pero' le decisioni
+di fornitore/memoria una volta sola per fattura e la normalizzazione una volta per
+descrizione distinta. Il batch e' il percorso di estrai_dati_da_xml: una
+divergenza qui cambierebbe la categoria delle fatture importate.
+"""
+import json
+import os
+from unittest.mock import MagicMock, patch
+
+import pytest
+
+import services.ai_service as ai
+from services.ai_service import categorizza_batch, categorizza_con_memoria
+
+_FIXTURE = os.path.join(os.path.dirname(__file__), "fixtures", "golden_regole_categoria.json")
+
+with open(_FIXTURE, encoding="utf-8") as f:
+    _DESCRIZIONI = sorted({riga[0] for riga in json.load(f)})[:400]
+
+
+def _righe(descrizioni, prezzo=10.0, um="PZ", iva=10.0):
+    return [
+        {
+            "descrizione": d,
+            "prezzo": prezzo,
+            "quantita": 1.0,
+            "unita_misura": um,
+            "iva_percentuale": iva,
+            "totale_riga": prezzo,
+        }
+        for d in descrizioni
+    ]
+
+
+def _per_riga(righe, **kw):
+    return [
+        categorizza_con_memoria(return_fallback_flag=True, **kw, **r)
+        for r in righe
+    ]
+
+
+@pytest.mark.parametrize("fornitore", [None, "H.D. ITALIA S.R.L", "BRICOMAN ITALIA S.R.L.", "COMO ACQUA S.R.L"])
+def test_batch_identico_al_per_riga_senza_memoria(fornitore):
+    righe = _righe(_DESCRIZIONI)
+    sb = MagicMock()
+    atteso = _per_riga(righe, user_id=None, supabase_client=sb, fornitore=fornitore)
+    ottenuto = categorizza_batch(righe, user_id=None, fornitore=fornitore, supabase_client=sb)
+    assert ottenuto == atteso
+
+
+def test_batch_identico_con_prezzo_zero_e_righe_ripetute():
+    """Righe €0 (dicitura/quarantena) e descrizioni ripetute con importi diversi:
+    la memoizzazione per descrizione NON deve trascinare il guardrail importo."""
+    righe = _righe(["TRASPORTO", "MOZZARELLA FIOR DI LATTE"], prezzo=0.0)
+    righe += _righe(["TRASPORTO", "MOZZARELLA FIOR DI LATTE"], prezzo=12.5)
+    sb = MagicMock()
+    assert categorizza_batch(righe, user_id=None, supabase_client=sb) == _per_riga(
+        righe, user_id=None, supabase_client=sb
+    )
+
+
+def test_batch_usa_memoria_admin_locale_e_globale():
+    cache = ai._memoria_cache
+    with patch.dict(cache, {
+        "loaded": True,
+        "_loaded_user_ids": {"u1"},
+        "classificazioni_manuali": {"ARTICOLO ADMIN": {"categoria": "CARNE", "is_dicitura": False}},
+        "prodotti_utente": {"u1": {"ARTICOLO LOCALE": "PESCE"}},
+        "prodotti_utente_norm": {"u1": {}},
+        "prodotti_master": {"ARTICOLO GLOBALE": "VERDURE"},
+    }):
+        righe = _righe(["ARTICOLO ADMIN", "ARTICOLO LOCALE", "ARTICOLO GLOBALE", "ARTICOLO ADMIN"])
+        sb = MagicMock()
+        ottenuto = categorizza_batch(righe, user_id="u1", supabase_client=sb, pending_local_saves=[])
+        atteso = _per_riga(righe, user_id="u1", supabase_client=sb, pending_local_saves=[])
+    assert ottenuto == atteso
+    assert [c for c, _ in ottenuto] == ["CARNE", "PESCE", "VERDURE", "CARNE"]
+
+
+def test_decisioni_fornitore_una_volta_per_batch():
+    righe = _righe(_DESCRIZIONI[:50])
+    with patch.object(ai, "_is_fornitore_utenze_sempre", wraps=ai._is_fornitore_utenze_sempre) as spia, \
+         patch.object(ai, "get_descrizione_normalizzata_e_originale",
+                      wraps=ai.get_descrizione_normalizzata_e_originale) as norm:
+        categorizza_batch(righe + righe, user_id=None, fornitore="H.D. ITALIA S.R.L", supabase_client=MagicMock())
+    assert spia.call_count == 1
+    # normalizzazione una volta per descrizione distinta, non per riga
+    assert norm.call_count == len(set(_DESCRIZIONI[:50]))
+
+
+def test_fornitore_per_riga_in_batch_di_coda():
+    """Batch di coda con piu' fatture: la chiave 'fornitore' della riga prevale."""
+    righe = _righe(["PACK MINUTI ILLIMITATI", "PACK MINUTI ILLIMITATI"])
+    righe[0]["fornitore"] = "COMO ACQUA S.R.L"
+    esiti = categorizza_batch(righe, user_id=None, fornitore=None, supabase_client=MagicMock())
+    assert esiti[0][0] == "UTENZE E LOCALI"
+    assert esiti[1] == categorizza_con_memoria(
+        return_fallback_flag=True, user_id=None, supabase_client=MagicMock(), **_righe(["PACK MINUTI ILLIMITATI"])[0]
+    )
+
+
+def test_accumula_pending_local_saves_come_per_riga():
+    righe = _righe(["OLIO EXTRAVERGINE", "FARINA 00", "OLIO EXTRAVERGINE"])
+    pend_batch, pend_riga = [], []
+    sb = MagicMock()
+    with patch.object(ai, "carica_memoria_completa", return_value=None):
+        categorizza_batch(righe, user_id="u2", supabase_client=sb, pending_local_saves=pend_batch)
+        _per_riga(righe, user_id="u2", supabase_client=sb, pending_local_saves=pend_riga)
+    assert pend_batch == pend_riga
+    assert pend_batch
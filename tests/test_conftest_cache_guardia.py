@@ -24,6 +24,7 @@ from tests.conftest import (
     CACHE_AI_MINUSCOLE,
     CACHE_AUTH,
     CACHE_ESCLUSE,
+    CACHE_GRUPPO,
     CACHE_WORKER,
 )
 
@@ -52,6 +53,7 @@ def _cache_dichiarate(percorso_relativo):
         ("services/fastapi_worker.py", set(CACHE_WORKER)),
         ("services/auth_service.py", set(CACHE_AUTH)),
         ("services/routers/admin.py", set(CACHE_ADMIN)),
+        ("services/routers/gruppo.py", set(CACHE_GRUPPO)),
         ("services/ai_service.py", set(CACHE_AI_MINUSCOLE)),
     ],
 )
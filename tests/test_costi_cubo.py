@@ -0,0 +1,242 @@
+"""Cubo dei costi mensili (services/costi_cubo) e chiamanti portati sul cubo.
+
+La tabella la mantiene il DB; qui si fissa che le letture dal cubo diano gli
+stessi numeri del calcolo sulle righe fattura (costi auto del MOL, costo per
+categoria dei centri, dashboard Home, tool costi della chat) e che i tratti
+di periodo che il cubo non copre, o un cubo che non risponde, passino dalle
+righe.
+"""
+import asyncio
+import re
+from collections import defaultdict
+from pathlib import Path
+from unittest.mock import MagicMock, patch
+
+import httpx
+
+import services.fastapi_worker as fw
+from services import costi_cubo
+from services.supabase_async import AsyncPostgrest
+
+_MIGRATIONS = Path(__file__).resolve().parents[1] / "supabase" / "migrations"
+
+_RIGHE = [
+    {"id": 1, "user_id": "u1", "data_documento": "2026-01-20", "data_competenza": None,
+     "categoria": "CARNE", "fornitore": "Macelleria", "totale_riga": 100.0, "ripartita_su_gruppo": False},
+    {"id": 2, "user_id": "u1", "data_documento": "2026-01-31", "data_competenza": "2026-02-01",
+     "categoria": "CARNE", "fornitore": "Macelleria", "totale_riga": -20.0, "ripartita_su_gruppo": False},
+    {"id": 3, "user_id": "u1", "data_documento": "2026-02-03", "data_competenza": None,
+     "categoria": "UTENZE E LOCALI", "fornitore": "Enel", "totale_riga": 300.0, "ripartita_su_gruppo": False},
+    {"id": 4, "user_id": "u1", "data_documento": "2026-02-05", "data_competenza": None,
+     "categoria": "📝 NOTE E DICITURE", "fornitore": "Enel", "totale_riga": 2.0, "ripartita_su_gruppo": False},
+    {"id": 5, "user_id": "u1", "data_documento": "2026-02-07", "data_competenza": None,
+     "categoria": "Da Classificare", "fornitore": "Bar", "totale_riga": 40.0, "ripartita_su_gruppo": False},
+    {"id": 6, "user_id": "u1", "data_documento": "2026-02-09", "data_competenza": None,
+     "categoria": "PESCE", "fornitore": "Commercialista", "totale_riga": 500.0, "ripartita_su_gruppo": True},
+]
+
+
+def _celle_mensili(righe, base=costi_cubo.BASE_COMPETENZA, rid="r1"):
+    """Le celle che costi_cubo_mensili restituirebbe per queste righe."""
+    acc = defaultdict(lambda: {"totale": 0.0, "totale_positivo": 0.0, "n_righe": 0})
+    for (anno, mese, anno_doc, mese_doc, cat, _forn, fonte, _uid), v in costi_cubo.celle_da_righe(righe).items():
+        chiave = (anno_doc, mese_doc) if base == costi_cubo.BASE_DOCUMENTO else (anno, mese)
+        cella = acc[(*chiave, cat, fonte)]
+        for k in cella:
+            cella[k] += v[k]
+    return [
+        {"ristorante_id": rid, "anno": a, "mese": m, "categoria": c, "fonte": f, **v}
+        for (a, m, c, f), v in sorted(acc.items())
+    ]
+
+
+class _FakeQuery:
+    """Applica eq/neq/is_ alle righe; ignora periodo e pagine (una sola pagina)."""
+
+    def __init__(self, rows):
+        self._rows = rows
+
+    def select(self, *_a, **_k):
+        return self
+
+    def eq(self, field, value):
+        self._rows = [r for r in self._rows if r.get(field) == value]
+        return self
+
+    def neq(self, field, value):
+        self._rows = [r for r in self._rows if r.get(field) != value]
+        return self
+
+    def is_(self, field, value):
+        self._rows = [r for r in self._rows if (r.get(field) is None) == (str(value) == "null")]
+        return self
+
+    def or_(self, *_a, **_k):
+        return self
+
+    def range(self, *_a, **_k):
+        return self
+
+    def execute(self):
+        return MagicMock(data=self._rows)
+
+
+def _sb_righe(righe):
+    sb = MagicMock()
+    sb.table.side_effect = lambda _t: _FakeQuery([{**r, "ristorante_id": "r1", "deleted_at": None} for r in righe])
+    return sb
+
+
+def test_costi_auto_dal_cubo_uguali_alle_righe():
+    mesi = [(2026, 1), (2026, 2), (2026, 3)]
+    with patch.object(costi_cubo, "leggi_mensile", side_effect=RuntimeError("cubo giu'")):
+        dalle_righe = fw._calcola_costi_auto_per_periodo(_sb_righe(_RIGHE), "r1", mesi)
+    with patch.object(costi_cubo, "leggi_mensile", return_value=_celle_mensili(_RIGHE)) as m:
+        dal_cubo = fw._calcola_costi_auto_per_periodo(MagicMock(), "r1", mesi)
+    assert m.call_args.args[1:] == (2026, 2026)
+    assert dal_cubo == dalle_righe == {
+        (2026, 1): (100.0, 0.0),
+        (2026, 2): (-20.0, 300.0),  # competenza, note/da classificare/ripartite fuori
+        (2026, 3): (0.0, 0.0),
+    }
+    with patch.object(costi_cubo, "leggi_mensile", return_value=_celle_mensili(_RIGHE)):
+        assert fw._calcola_costi_auto_per_mese(MagicMock(), "r1", 2026, 2) == (-20.0, 300.0)
+
+
+def test_costo_per_categoria_mesi_interi_dal_cubo_bordi_dalle_righe():
+    quota = {"ristorante_id": "r1", "anno": 2026, "mese": 2, "categoria": "CARNE",
+             "fonte": costi_cubo.FONTE_QUOTA, "totale": 70.0, "totale_positivo": 70.0, "n_righe": 1}
+    celle = _celle_mensili(_RIGHE, base=costi_cubo.BASE_DOCUMENTO) + [quota]
+    with patch.object(costi_cubo, "leggi_mensile", return_value=celle) as m_cubo, \
+         patch.object(fw, "_fb_per_categoria_e_mese_da_righe", return_value={(2026, 3, "CARNE"): 5.0}) as m_righe:
+        out = fw._load_fatture_fb_per_categoria_e_mese(MagicMock(), "r1", "2026-01-01", "2026-03-15")
+        per_cat = fw._load_fatture_fb_for_period(MagicMock(), "r1", "2026-01-01", "2026-03-15")
+    assert m_cubo.call_args.kwargs["base"] == costi_cubo.BASE_DOCUMENTO
+    assert m_righe.call_args.args[2:] == ("2026-03-01", "2026-03-15"), "solo il mese tagliato"
+    # Storno di gennaio escluso, ripartita fuori, quota di gruppo dentro.
+    assert out == {(2026, 1, "CARNE"): 100.0, (2026, 2, "CARNE"): 70.0, (2026, 3, "CARNE"): 5.0}
+    assert per_cat == {"CARNE": 175.0}
+
+
+def _fake_async_sb(celle, chiamate):
+    def handler(request: httpx.Request) -> httpx.Response:
+        path = request.url.path
+        chiamate.append((path, dict(request.url.params)))
+        if path.endswith("/rpc/dashboard_stats_aggregata"):
+            return httpx.Response(500, json={"message": "rpc down"})
+        if path.endswith("/costi_mensili_cubo"):
+            return httpx.Response(200, json=celle)
+        if path.endswith("/fatture_documenti"):
+            return httpx.Response(200, json=[{"file_origine": "a.xml"}], headers={"content-range": "0-0/4"})
+        if path.endswith("/fatture") and request.url.params.get("limit") == "1":
+            desc = request.url.params["order"].endswith("desc")
+            return httpx.Response(200, json=[{"data_documento": "2026-02-09" if desc else "2026-01-20"}])
+        return httpx.Response(404, json={"message": "non previsto"})
+
+    return AsyncPostgrest("https://x.supabase.co", "k", transport=httpx.MockTransport(handler))
+
+
+def test_dashboard_stats_dal_cubo_senza_caricare_le_righe():
+    fw._DASHBOARD_STATS_CACHE.invalidate()
+    celle = [
+        {"anno_doc": a, "mese_doc": m, "categoria": cat, "fornitore": forn, "fonte": fonte, **v}
+        for (_a, _m, a, m, cat, forn, fonte, _u), v in costi_cubo.celle_da_righe(_RIGHE).items()
+    ]
+    celle.append({"anno_doc": 2026, "mese_doc": 2, "categoria": "CARNE", "fornitore": "X",
+                  "fonte": costi_cubo.FONTE_QUOTA, "totale": 999.0, "n_righe": 1})
+    chiamate = []
+    sb = _fake_async_sb(celle, chiamate)
+
+    async def _run():
+        with patch.object(fw, "_resolve_user_from_token", return_value={"id": "u1"}), \
+             patch.object(fw, "_get_async_supabase_client", return_value=sb), \
+             patch.object(fw, "_resolve_ristorante_id_async", return_value="r1"), \
+             patch.object(fw, "_oggi_rome", return_value=fw.date(2026, 3, 10)):
+            return await fw.dashboard_stats(authorization="Bearer t")
+
+    out = asyncio.run(_run())
+    assert out.kpi.righe_totali == 6 and out.kpi.fatture_uniche == 4
+    assert out.kpi.spesa_totale == 922.0, "quote di gruppo fuori, come sulle righe"
+    assert out.kpi.spesa_mese_precedente == 842.0
+    assert (out.kpi.prima_fattura, out.kpi.ultima_fattura) == ("2026-01-20", "2026-02-09")
+    assert [(p.mese, p.spesa) for p in out.spesa_mensile] == [("2026-01", 80.0), ("2026-02", 842.0)]
+    assert [(t.nome, t.spesa, t.righe) for t in out.top_fornitori][:2] == [("Commercialista", 500.0, 1), ("Enel", 302.0, 2)]
+    assert not any(p.get("order") == "id.asc" for _, p in chiamate), "nessun full-load delle righe"
+
+
+def test_chat_costi_per_categoria_dal_cubo():
+    celle = _celle_mensili(_RIGHE, base=costi_cubo.BASE_DOCUMENTO)
+    sb = MagicMock()
+    with patch.object(costi_cubo, "leggi_mensile", return_value=celle) as m:
+        out = fw._chat_query_costi("u1", sb, mese=2, anno=2026, ristorante_id="r1")
+    assert m.call_args.kwargs["user_id"] == "u1"
+    assert sb.table.call_count == 0
+    assert out["totale"] == 842.0 and out["righe_trovate"] == 4
+    assert out["dettaglio"][0] == {"voce": "PESCE", "spesa": 500.0}
+    assert out["incluso_da_classificare"] == 40.0 and "totale_parziale" not in out
+
+
+def test_confronta_celle_attese_e_tabella():
+    attese = costi_cubo.celle_da_righe(_RIGHE[:2])
+    tabella = [
+        {"anno": a, "mese": m, "anno_doc": ad, "mese_doc": md, "categoria": c, "fornitore": f,
+         "fonte": fo, "user_id": u, **v}
+        for (a, m, ad, md, c, f, fo, u), v in attese.items()
+    ]
+    assert costi_cubo.confronta(attese, tabella)["coerente"]
+
+    tabella[0]["totale"] += 1
+    esito = costi_cubo.confronta(attese, tabella[:1] + [{**tabella[1], "categoria": "PESCE"}])
+    assert not esito["coerente"]
+    assert esito["n_mancanti"] == 1 and esito["n_in_eccesso"] == 1
+    assert esito["diverse"][0]["campi"] == ["totale"]
+
+
+def test_ricalcolo_quote_in_fila_per_pv_e_senza_violazioni_di_chiave():
+    """Due riparti concorrenti sulla stessa catena ricalcolano le quote degli
+    stessi PV: la definizione applicata per ultima li mette in fila con un lock
+    per PV prima della delete e non fallisce sulla chiave primaria del cubo."""
+    pattern = re.compile(
+        r"create or replace function public\.costi_cubo_ricalcola_quote\(.*?\$\$;", re.DOTALL | re.IGNORECASE,
+    )
+    definizioni = [m.group(0) for f in sorted(_MIGRATIONS.glob("*.sql"))
+                   for m in pattern.finditer(f.read_text(encoding="utf-8"))]
+    sql = " ".join(definizioni[-1].lower().split())
+    assert "pg_advisory_xact_lock(" in sql and "order by r.id" in sql
+    assert sql.index("pg_advisory_xact_lock(") < sql.index("delete from public.costi_mensili_cubo")
+    assert ("on conflict (ristorante_id, anno, mese, anno_doc, mese_doc, categoria, fornitore, fonte, user_id) "
+            "do update set totale = excluded.totale, totale_positivo = excluded.totale_positivo, "
+            "n_righe = excluded.n_righe") in sql
+
+
+def test_categoria_vuota_fuori_dal_mol_su_rpc_e_fallback_pandas():
+    """Stesse righe, una con categoria '': la RPC sul cubo e il fallback pandas
+    danno lo stesso MOL (la riga vuota resta fuori da entrambi)."""
+    from config.constants import CATEGORIE_SPESE_GENERALI
+    from services import margine_service as ms
+
+    righe = _RIGHE + [
+        {"id": 7, "user_id": "u1", "data_documento": "2026-02-11", "data_competenza": None,
+         "categoria": "", "fornitore": "Senza", "totale_riga": 60.0, "ripartita_su_gruppo": False},
+    ]
+    # Quello che costi_automatici_mensili calcola dal cubo per queste righe.
+    dal_cubo = costi_cubo.costi_automatici(
+        _celle_mensili(righe), spese=CATEGORIE_SPESE_GENERALI, escluse={"📝 NOTE E DICITURE"},
+    )
+    sb_rpc = MagicMock()
+    sb_rpc.rpc.return_value.execute.return_value = MagicMock(data=[
+        {"mese": m, "food": fb, "spese": sp} for (_rid, _a, m), (fb, sp) in sorted(dal_cubo.items())
+    ])
+    sb_righe = _sb_righe(righe)
+    sb_righe.rpc.side_effect = RuntimeError("rpc giu'")
+
+    ms.calcola_costi_automatici_per_anno.clear()
+    with patch.object(ms, "get_supabase_client", return_value=sb_rpc):
+        via_rpc = ms.calcola_costi_automatici_per_anno_sql("u1", "r1", 2026)
+    with patch.object(ms, "get_supabase_client", return_value=sb_righe):
+        via_pandas = ms.calcola_costi_automatici_per_anno_sql("u1", "r1", 2026)
+    ms.calcola_costi_automatici_per_anno.clear()
+
+    assert via_pandas == via_rpc == ({1: 100.0, 2: -20.0}, {2: 300.0})
+    with patch.object(costi_cubo, "leggi_mensile", side_effect=RuntimeError("cubo giu'")):
+        assert fw._calcola_costi_auto_per_periodo(sb_righe, "r1", [(2026, 2)]) == {(2026, 2): (-20.0, 300.0)}
@@ -6,11 +6,18 @@ aggregava in Python a ogni apertura Home. Ora chiama dashboard_stats_aggregata
 (GROUP BY lato DB). Questi test bloccano due regressioni:
   - la risposta RPC viene mappata fedelmente su DashboardStats (KPI, mensile, top);
   - se la RPC lancia, NON si rompe: si ricade sul percorso storico.
+
+L'endpoint e' async e parla col client PostgREST async (services/supabase_async):
+il DB finto e' un httpx.MockTransport, cosi' passa dal client vero.
 """
-from types import SimpleNamespace
-from unittest.mock import MagicMock, patch
+import asyncio
+import json
+from unittest.mock import patch
+
+import httpx
 
 import services.fastapi_worker as fw
+from services.supabase_async import AsyncPostgrest
 
 
 _AGG = {
@@ -37,22 +44,37 @@ _AGG = {
 }
 
 
-def _fake_sb(rpc_data=None, rpc_raises=False):
-    sb = MagicMock()
-    if rpc_raises:
-        sb.rpc.side_effect = RuntimeError("rpc down")
-    else:
-        sb.rpc.return_value.execute.return_value = SimpleNamespace(data=rpc_data)
-    return sb
+def _fake_sb(rpc_data=None, rpc_raises=False, righe=None):
+    """Client async su MockTransport; `chiamate` registra (metodo, path, query)."""
+    chiamate = []
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        chiamate.append((request.method, request.url.path, dict(request.url.params)))
+        if request.url.path.endswith("/rpc/dashboard_stats_aggregata"):
+            if rpc_raises:
+                return httpx.Response(500, json={"message": "rpc down"})
+            return httpx.Response(200, json=rpc_data)
+        if request.url.path.endswith("/fatture"):
+            return httpx.Response(200, json=righe or [])
+        return httpx.Response(404, json={"message": "non previsto"})
+
+    sb = AsyncPostgrest("https://x.supabase.co", "k", transport=httpx.MockTransport(handler))
+    return sb, chiamate
+
+
+def _chiama(sb, ristorante_id):
+    async def _run():
+        with patch.object(fw, "_resolve_user_from_token", return_value={"id": "u1"}), \
+             patch.object(fw, "_get_async_supabase_client", return_value=sb), \
+             patch.object(fw, "_resolve_ristorante_id_async", return_value=ristorante_id):
+            return await fw.dashboard_stats(authorization="Bearer t")
+    return asyncio.run(_run())
 
 
 def test_dashboard_stats_usa_rpc_e_mappa_i_campi():
-    fw._DASHBOARD_STATS_CACHE.clear()
-    sb = _fake_sb(rpc_data=_AGG)
-    with patch.object(fw, "_resolve_user_from_token", return_value={"id": "u1"}), \
-         patch("services.get_supabase_client", return_value=sb), \
-         patch.object(fw, "_resolve_ristorante_id", return_value="r1"):
-        out = fw.dashboard_stats(authorization="Bearer t")
+    fw._DASHBOARD_STATS_CACHE.invalidate()
+    sb, chiamate = _fake_sb(rpc_data=_AGG)
+    out = _chiama(sb, "r1")
 
     assert out.kpi.fatture_uniche == 553
     assert out.kpi.righe_totali == 6315
@@ -64,26 +86,38 @@ def test_dashboard_stats_usa_rpc_e_mappa_i_campi():
     assert out.top_categorie[0].nome == "PESCE"
     # La RPC deve essere stata chiamata col nome giusto e NON deve essere partito
     # il full-load (table('fatture') non interrogata sul path veloce).
-    sb.rpc.assert_called_once()
-    assert sb.rpc.call_args[0][0] == "dashboard_stats_aggregata"
+    assert [(m, p) for m, p, _ in chiamate] == [("POST", "/rest/v1/rpc/dashboard_stats_aggregata")]
 
 
 def test_dashboard_stats_fallback_se_rpc_lancia():
     """Se la RPC lancia, l'endpoint deve ricadere sul full-load senza errori."""
-    fw._DASHBOARD_STATS_CACHE.clear()
-    sb = _fake_sb(rpc_raises=True)
-
-    # Sul fallback parte table('fatture').select()...range().execute(): mockiamo
-    # una risposta vuota -> stats a zero, ma SENZA eccezione (è ciò che testiamo).
-    _empty = SimpleNamespace(data=[])
-    sb.table.return_value.select.return_value.eq.return_value.is_.return_value.eq.return_value.range.return_value.execute.return_value = _empty
-    sb.table.return_value.select.return_value.eq.return_value.is_.return_value.range.return_value.execute.return_value = _empty
-
-    with patch.object(fw, "_resolve_user_from_token", return_value={"id": "u1"}), \
-         patch("services.get_supabase_client", return_value=sb), \
-         patch.object(fw, "_resolve_ristorante_id", return_value=None):
-        out = fw.dashboard_stats(authorization="Bearer t")
+    fw._DASHBOARD_STATS_CACHE.invalidate()
+    sb, chiamate = _fake_sb(rpc_raises=True)
+    out = _chiama(sb, None)
 
     # Non deve sollevare: ritorna stats vuote dal percorso Python.
     assert out.kpi.righe_totali == 0
     assert out.kpi.spesa_totale == 0
+    assert chiamate[-1][1] == "/rest/v1/fatture"
+
+
+def test_dashboard_stats_fallback_aggrega_le_righe():
+    fw._DASHBOARD_STATS_CACHE.invalidate()
+    righe = [
+        {"file_origine": "a.xml", "data_documento": "2026-03-02", "fornitore": "ADC",
+         "categoria": "PESCE", "totale_riga": 100.0},
+        {"file_origine": "a.xml", "data_documento": "2026-03-02", "fornitore": "ADC",
+         "categoria": "CARNE", "totale_riga": 50.0},
+        {"file_origine": "b.xml", "data_documento": "2026-04-10", "fornitore": " ",
+         "categoria": None, "totale_riga": 25.5},
+    ]
+    sb, chiamate = _fake_sb(rpc_raises=True, righe=righe)
+    out = _chiama(sb, "r1")
+
+    assert out.kpi.fatture_uniche == 2 and out.kpi.righe_totali == 3
+    assert out.kpi.spesa_totale == 175.5
+    assert out.top_fornitori[0].nome == "ADC" and out.top_fornitori[1].nome == "—"
+    params = chiamate[-1][2]
+    assert params["ristorante_id"] == "eq.r1" and params["deleted_at"] == "is.null"
+    # Keyset: prima pagina senza offset, ordinata per id.
+    assert "offset" not in params and params["limit"] == "1000" and params["order"] == "id.asc"
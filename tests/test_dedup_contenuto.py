@@ -0,0 +1,117 @@
+"""Dedup per contenuto (services/dedup_contenuto) e corto circuito del queue-worker.
+
+Il fake Supabase tiene due tabelle in memoria: `fatture_hash_contenuto`
+(registrazioni) e `fatture` (righe con deleted_at), quanto basta per verificare
+che il duplicato si dichiari solo se la fattura e' ancora attiva.
+"""
+import pytest
+
+from services import dedup_contenuto as dc
+from worker import queue_processor as qp
+
+_XML = b'<?xml version="1.0"?><FatturaElettronica><Body><Numero>1</Numero></Body></FatturaElettronica>'
+
+
+class _Query:
+    def __init__(self, db, tabella):
+        self.db, self.tabella, self.filtri = db, tabella, []
+
+    def select(self, *_a, **_k):
+        return self
+
+    def eq(self, campo, valore):
+        self.filtri.append(lambda r: r.get(campo) == valore)
+        return self
+
+    def is_(self, campo, _null):
+        self.filtri.append(lambda r: r.get(campo) is None)
+        return self
+
+    def limit(self, _n):
+        return self
+
+    def upsert(self, riga, on_conflict=""):
+        chiavi = on_conflict.split(",")
+        righe = self.db.setdefault(self.tabella, [])
+        righe[:] = [r for r in righe if any(r.get(k) != riga.get(k) for k in chiavi)]
+        righe.append(dict(riga))
+        return self
+
+    def execute(self):
+        self.db["letture"] = self.db.get("letture", 0) + 1
+        righe = [r for r in self.db.get(self.tabella, []) if all(f(r) for f in self.filtri)]
+        return type("R", (), {"data": righe})()
+
+
+class _FakeSupabase:
+    def __init__(self):
+        self.db = {}
+
+    def table(self, nome):
+        return _Query(self.db, nome)
+
+
+@pytest.fixture
+def sb():
+    s = _FakeSupabase()
+    s.db["fatture"] = [{"ristorante_id": "r1", "file_origine": "A.xml", "deleted_at": None}]
+    return s
+
+
+def test_hash_ignora_varianti_non_significative():
+    base = dc.hash_contenuto_xml(_XML)
+    assert dc.hash_contenuto_xml(b'\xef\xbb\xbf' + _XML + b'\r\n') == base
+    assert dc.hash_contenuto_xml(_XML.replace(b'><Body>', b'>\r\n  <Body>')) == base
+    assert dc.hash_contenuto_xml(_XML.decode()) == base
+    assert dc.hash_contenuto_xml(_XML.replace(b'<Numero>1<', b'<Numero>2<')) != base
+
+
+def test_registrato_e_attivo_e_duplicato(sb):
+    h = dc.hash_contenuto_xml(_XML)
+    assert dc.documento_gia_elaborato(sb, "r1", h) is None
+    dc.registra_documento_elaborato(sb, "r1", "u1", h, "A.xml", righe=3)
+    assert dc.documento_gia_elaborato(sb, "r1", h) == "A.xml"
+    assert dc.documento_gia_elaborato(sb, "r2", h) is None, "la chiave e' per sede"
+
+    # Dopo un riavvio (LRU vuota) la registrazione si rilegge dalla tabella.
+    dc.svuota_cache()
+    assert dc.documento_gia_elaborato(sb, "r1", h) == "A.xml"
+    assert sb.db["fatture_hash_contenuto"][0]["righe"] == 3
+
+
+def test_fattura_eliminata_si_rielabora(sb):
+    h = dc.hash_contenuto_xml(_XML)
+    dc.registra_documento_elaborato(sb, "r1", "u1", h, "A.xml")
+    sb.db["fatture"][0]["deleted_at"] = "2026-10-01T00:00:00Z"
+    assert dc.documento_gia_elaborato(sb, "r1", h) is None
+    assert ("r1", h) not in dc._HASH_CONTENUTO_CACHE
+
+
+def test_errori_non_bloccanti():
+    class _Rotto:
+        def table(self, _n):
+            raise RuntimeError("db giu'")
+
+    h = dc.hash_contenuto_xml(_XML)
+    assert dc.documento_gia_elaborato(_Rotto(), "r1", h) is None
+    dc.registra_documento_elaborato(_Rotto(), "r1", "u1", h, "A.xml")  # non solleva
+
+
+def test_lru_limitata(monkeypatch, sb):
+    monkeypatch.setattr(dc, "_LRU_MAX", 2)
+    for i in range(3):
+        dc.registra_documento_elaborato(sb, "r1", "u1", f"h{i}", "A.xml")
+    assert list(dc._HASH_CONTENUTO_CACHE) == [("r1", "h1"), ("r1", "h2")]
+
+
+def test_queue_worker_salta_il_parse_dei_contenuti_noti(monkeypatch, sb):
+    dc.registra_documento_elaborato(sb, "r1", "u1", dc.hash_contenuto_xml(_XML), "A.xml")
+
+    def _vietato(*_a, **_k):
+        raise AssertionError("contenuto gia' elaborato: niente parse")
+
+    monkeypatch.setattr(qp, "estrai_dati_da_xml", _vietato)
+    item = {"id": 7, "event_id": "e7", "user_id": "u1", "ristorante_id": "r1",
+            "xml_content": _XML.decode(), "payload_meta": {"nome_file": "A (1).xml"}}
+    esito = qp._process_item(sb, item)
+    assert (esito.status, esito.righe) == ("done", 0)
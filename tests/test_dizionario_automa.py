@@ -0,0 +1,86 @@
+"""Test per l'automa keyword di applica_correzioni_dizionario.
+
+L'automa (utils/keyword_automaton) ha sostituito i 4 loop di re.search sul
+dizionario: deve dare lo STESSO output dei pattern regex storici, keyword per
+keyword, incluse le priorita' (piu' lunga prima, cibi prima dei contenitori,
+fallback doppie collassate). Il riferimento regex resta in ai_service come
+_cerca_keyword_dizionario_regex proprio per questo test.
+"""
+import json
+import os
+
+import pytest
+
+from config.constants import DIZIONARIO_CORREZIONI
+from services.ai_service import (
+    _cerca_keyword_dizionario,
+    _cerca_keyword_dizionario_regex,
+    applica_correzioni_dizionario,
+)
+from utils.keyword_automaton import KeywordAutomaton
+
+_FIXTURE = os.path.join(os.path.dirname(__file__), "fixtures", "golden_regole_categoria.json")
+
+with open(_FIXTURE, encoding="utf-8") as f:
+    _DESCRIZIONI_GOLDEN = sorted({riga[0] for riga in json.load(f)})
+
+
+def test_equivalenza_regex_su_corpus_golden():
+    diverse = [
+        d for d in (x.upper() for x in _DESCRIZIONI_GOLDEN)
+        if _cerca_keyword_dizionario(d) != _cerca_keyword_dizionario_regex(d)
+    ]
+    assert diverse == []
+
+
+def test_equivalenza_regex_su_tutte_le_keyword():
+    """Ogni keyword da sola, e incollata a un codice GDO: copre i bordi."""
+    diverse = []
+    for kw in DIZIONARIO_CORREZIONI:
+        for d in (kw, f"200{kw} KG", f"{kw}X", f"CONF {kw}"):
+            if _cerca_keyword_dizionario(d) != _cerca_keyword_dizionario_regex(d):
+                diverse.append(d)
+    assert diverse == []
+
+
+@pytest.mark.parametrize("desc", [
+    "MOZZARELA FIORDILATTE 125G",   # fallback doppie collassate
+    "VASCHETTA ALLUMINIO 2 PORZ",    # solo contenitore
+    "SALSICCIA VASC 1KG",            # alimento batte contenitore
+    "ZZZ CODICE 123 SENZA KEYWORD",  # nessun match
+    "",
+])
+def test_applica_correzioni_invariata_casi_noti(desc):
+    atteso = _cerca_keyword_dizionario_regex(desc.upper())
+    assert _cerca_keyword_dizionario(desc.upper()) == atteso
+    if atteso is None and desc:
+        assert applica_correzioni_dizionario(desc, "Da Classificare") == "Da Classificare"
+
+
+def test_automa_rango_minimo_vince():
+    automa = KeywordAutomaton(["MOZZARELLA", "MOZZ", "VASC"])
+    assert automa.miglior_rango(" VASC MOZZ MOZZARELLA ") == 0
+    assert automa.miglior_rango(" VASC MOZZ ") == 1
+    assert automa.miglior_rango(" NIENTE ") is None
+    assert len(automa) == 3
+
+
+def test_automa_bordi_come_regex():
+    automa = KeywordAutomaton(["OLIO"])
+    # bordo sinistro: cifra ammessa (codici GDO), lettera no
+    assert automa.miglior_rango(" 5OLIO ") == 0
+    assert automa.miglior_rango(" PETROLIO ") is None
+    # bordo destro: la cifra NON e' un bordo
+    assert automa.miglior_rango(" OLIO5 ") is None
+    assert automa.miglior_rango("OLIO") == 0
+    # lettere accentate sono caratteri-parola anche per l'automa
+    assert automa.miglior_rango(" OLIOÈ ") is None
+
+
+def test_automa_keyword_suffisso_di_altra():
+    """Le uscite ereditate via link di fallimento: 'ASALMONE' contiene 'SALMONE'
+    ma senza bordo sinistro; 'SALMONE' da solo si'."""
+    automa = KeywordAutomaton(["AFFUMICATO SALMONE", "SALMONE"])
+    assert automa.miglior_rango(" AFFUMICATO SALMONE ") == 0
+    assert automa.miglior_rango(" AFFUMICATOSALMONE ") is None
+    assert automa.miglior_rango(" XAFFUMICATO SALMONE ") == 1
@@ -0,0 +1,128 @@
+"""Parser FatturaPA a eventi (services/fatturapa_parser).
+
+Tre garanzie: la testata ha la stessa forma del dict xmltodict usato dagli
+estrattori di routing/fornitore; i campi del body sono quelli che
+estrai_dati_da_xml leggeva con safe_get (primo CodiceArticolo, Tipo sconto di
+default 'SC', DatiPagamento in entrambe le posizioni); XXE, entity expansion e
+XML malformato sono rifiutati con ValueError come faceva decodifica_xml_sicuro.
+"""
+import pytest
+
+from services.fatturapa_parser import XMLNonSicuro, parse_fattura
+from services.invoice_service import _estrai_info_pagamento_xml, estrai_piva_cessionario_xml
+
+_HEADER = (
+    '<FatturaElettronicaHeader><CedentePrestatore><DatiAnagrafici><IdFiscaleIVA>'
+    '<IdPaese>IT</IdPaese><IdCodice>01234567890</IdCodice></IdFiscaleIVA>'
+    '<Anagrafica><Denominazione>{den}</Denominazione></Anagrafica></DatiAnagrafici></CedentePrestatore>'
+    '<CessionarioCommittente><DatiAnagrafici><IdFiscaleIVA><IdPaese>IT</IdPaese>'
+    '<IdCodice>09876543210</IdCodice></IdFiscaleIVA></DatiAnagrafici>'
+    '<Sede><Indirizzo>VIA ROMA</Indirizzo><CAP>20100</CAP></Sede><Sede><Indirizzo>VIA MILANO</Indirizzo></Sede>'
+    '</CessionarioCommittente></FatturaElettronicaHeader>'
+)
+
+
+def _xml(body, den="GROSSISTA SPA", encoding="UTF-8"):
+    return (
+        f'<?xml version="1.0" encoding="{encoding}"?>'
+        '<p:FatturaElettronica xmlns:p="http://ivaservizi.agenziaentrate.gov.it/docs/xsd/fatture/v1.2" '
+        f'versione="FPR12">{_HEADER.format(den=den)}{body}</p:FatturaElettronica>'
+    )
+
+
+_BODY = (
+    '<FatturaElettronicaBody><DatiGenerali><DatiGeneraliDocumento><TipoDocumento>TD24</TipoDocumento>'
+    '<Data>2026-03-02</Data><Numero> 15/A </Numero><ImportoTotaleDocumento>12.10</ImportoTotaleDocumento>'
+    '</DatiGeneraliDocumento><DatiDDT><NumeroDDT>9</NumeroDDT><DataDDT>2026-03-01</DataDDT>'
+    '<RiferimentoNumeroLinea>1</RiferimentoNumeroLinea><RiferimentoNumeroLinea>2</RiferimentoNumeroLinea>'
+    '</DatiDDT><DatiDDT><NumeroDDT>10</NumeroDDT><DataDDT>2026-03-02</DataDDT></DatiDDT>'
+    '<DatiPagamento><DettaglioPagamento><GiorniTerminiPagamento>30</GiorniTerminiPagamento>'
+    '</DettaglioPagamento></DatiPagamento></DatiGenerali>'
+    '<DatiBeniServizi><DettaglioLinee><NumeroLinea>1</NumeroLinea>'
+    '<CodiceArticolo><CodiceTipo>EAN</CodiceTipo><CodiceValore>800123</CodiceValore></CodiceArticolo>'
+    '<CodiceArticolo><CodiceTipo>INT</CodiceTipo><CodiceValore>A1</CodiceValore></CodiceArticolo>'
+    '<Descrizione>MOZZARELLA</Descrizione><Quantita>2.00</Quantita><UnitaMisura>KG</UnitaMisura>'
+    '<PrezzoUnitario>5.00</PrezzoUnitario><ScontoMaggiorazione><Percentuale>10.00</Percentuale>'
+    '</ScontoMaggiorazione><ScontoMaggiorazione><Tipo>MG</Tipo><Percentuale>2.00</Percentuale>'
+    '</ScontoMaggiorazione><PrezzoTotale>9.20</PrezzoTotale><AliquotaIVA>4.00</AliquotaIVA>'
+    '<AltriDatiGestionali><TipoDato>X</TipoDato><RiferimentoTesto>Descrizione</RiferimentoTesto>'
+    '</AltriDatiGestionali></DettaglioLinee>'
+    '<DettaglioLinee><NumeroLinea>2</NumeroLinea><Descrizione></Descrizione><PrezzoTotale>1.00</PrezzoTotale>'
+    '</DettaglioLinee>'
+    '<DatiRiepilogo><ImponibileImporto>10.20</ImponibileImporto><Imposta>0.41</Imposta></DatiRiepilogo>'
+    '</DatiBeniServizi>'
+    '<DatiPagamento><DettaglioPagamento><DataScadenzaPagamento>2026-04-30</DataScadenzaPagamento>'
+    '</DettaglioPagamento><DettaglioPagamento><DataScadenzaPagamento>2026-05-31</DataScadenzaPagamento>'
+    '</DettaglioPagamento></DatiPagamento></FatturaElettronicaBody>'
+)
+
+
+def test_testata_in_forma_xmltodict():
+    fpa = parse_fattura(_xml(_BODY).encode())
+    hdr = fpa.testata["FatturaElettronicaHeader"]
+    assert hdr["CedentePrestatore"]["DatiAnagrafici"]["Anagrafica"] == {"Denominazione": "GROSSISTA SPA"}
+    assert hdr["CessionarioCommittente"]["Sede"] == [
+        {"Indirizzo": "VIA ROMA", "CAP": "20100"}, {"Indirizzo": "VIA MILANO"},
+    ], "elementi ripetuti → lista, come xmltodict"
+    assert "FatturaElettronicaBody" not in fpa.testata
+    assert estrai_piva_cessionario_xml(fpa.testata) == "09876543210"
+
+
+def test_campi_del_body():
+    corpo = parse_fattura(_xml(_BODY).encode()).corpi[0]
+    assert (corpo.tipo_documento, corpo.data, corpo.numero, corpo.importo_totale) == (
+        "TD24", "2026-03-02", "15/A", "12.10")
+    assert corpo.riepiloghi == [["10.20", "0.41"]]
+    assert corpo.ddt == [["2026-03-01", ["1", "2"]], ["2026-03-02", []]]
+    prima, seconda = corpo.righe()
+    assert prima.codice_articolo == "800123", "solo il primo CodiceArticolo"
+    assert prima.sconti == [["SC", "10.00"], ["MG", "2.00"]], "Tipo assente → SC"
+    assert (prima.descrizione, prima.quantita, prima.unita_misura, prima.prezzo_unitario,
+            prima.prezzo_totale, prima.aliquota_iva) == ("MOZZARELLA", "2.00", "KG", "5.00", "9.20", "4.00")
+    assert seconda.descrizione is None and seconda.codice_articolo == ""
+    # Body/DatiPagamento canonico ha la precedenza su DatiGenerali/DatiPagamento.
+    assert _estrai_info_pagamento_xml(corpo, "TD24") == {"scadenza_xml": "2026-05-31", "giorni_termini_xml": None}
+    corpo.pagamenti = []
+    assert _estrai_info_pagamento_xml(corpo, "TD24") == {"scadenza_xml": None, "giorni_termini_xml": 30}
+
+
+def test_righe_fuori_da_dati_beni_servizi():
+    body = ('<FatturaElettronicaBody><DettaglioLinee><Descrizione>CONSULENZA</Descrizione>'
+            '<PrezzoTotale>100</PrezzoTotale></DettaglioLinee></FatturaElettronicaBody>')
+    corpo = parse_fattura(_xml(body)).corpi[0]
+    assert [r.descrizione for r in corpo.righe()] == ["CONSULENZA"]
+
+
+def test_lotto_multi_body():
+    doppio = _BODY + _BODY.replace("15/A", "16/A")
+    fpa = parse_fattura(_xml(doppio).encode())
+    assert fpa.n_corpi == 2 and [c.numero for c in fpa.corpi] == ["15/A", "16/A"]
+    solo = parse_fattura(_xml(doppio).encode(), solo_primo_corpo=True)
+    assert solo.n_corpi == 2 and [c.numero for c in solo.corpi] == ["15/A"]
+
+
+@pytest.mark.parametrize("xml", [
+    '<?xml version="1.0"?><!DOCTYPE a [<!ENTITY x SYSTEM "file:///etc/passwd">]><a>&x;</a>',
+    '<?xml version="1.0"?><!DOCTYPE a [<!ENTITY l "lol"><!ENTITY l2 "&l;&l;&l;">]><a>&l2;</a>',
+    '<?xml version="1.0"?><!DOCTYPE a [<!ENTITY % p SYSTEM "http://x/p.dtd"> %p;]><a/>',
+])
+def test_entita_rifiutate(xml):
+    with pytest.raises(XMLNonSicuro):
+        parse_fattura(xml.encode())
+
+
+def test_xml_malformato():
+    with pytest.raises(ValueError, match="XML non valido"):
+        parse_fattura(b"<a><b></a>")
+
+
+def test_encoding_dichiarato_e_ripiego():
+    body = _BODY.replace("MOZZARELLA", "CAFFÈ")
+    # Prolog onorato da expat (codifica a un byte).
+    assert parse_fattura(_xml(body, encoding="ISO-8859-1").encode("latin-1")).corpi[0].linee[0].descrizione == "CAFFÈ"
+    # Multibyte non supportato da expat → cascata di decodifica.
+    fpa = parse_fattura(_xml(_BODY, den="上海食品", encoding="GB2312").encode("gb2312"))
+    assert fpa.testata["FatturaElettronicaHeader"]["CedentePrestatore"]["DatiAnagrafici"]["Anagrafica"] == {
+        "Denominazione": "上海食品"}
+    # Prolog che mente: cp1252 dichiarato UTF-8.
+    assert parse_fattura(_xml(body).encode("cp1252")).corpi[0].linee[0].descrizione == "CAFFÈ"
@@ -0,0 +1,124 @@
+"""Dispatcher concorrente dei batch GPT (services/gpt_dispatcher).
+
+Token bucket con orologio finto (nessuna attesa reale), backoff 429 condiviso
+anche via file (simula un altro processo), batch adattivi, esecuzione in
+parallelo con risultati in ordine di completamento e ContextVar propagate.
+Il giro completo contro un finto server OpenAI HTTP e' in
+scripts/bench_gpt_dispatcher.py.
+"""
+import contextvars
+import threading
+import time
+from types import SimpleNamespace
+
+import pytest
+
+from services import gpt_dispatcher as gd
+
+
+@pytest.fixture(autouse=True)
+def _pulito():
+    gd.reset()
+    yield
+    gd.reset()
+
+
+class _Orologio:
+    def __init__(self):
+        self.t = 0.0
+
+    def __call__(self):
+        return self.t
+
+    def dormi(self, s):
+        self.t += s
+
+
+def test_token_bucket_rpm_e_tpm():
+    oro = _Orologio()
+    b = gd.TokenBucket(rpm=60, tpm=6000, orologio=oro, dormi=oro.dormi)
+    for _ in range(3):
+        assert b.acquisisci(2000) == 0.0
+    # Token finiti: servono 2000 token = 20 s di ricarica a 6000/min.
+    assert b.acquisisci(2000) == pytest.approx(20.0, abs=0.05)
+
+    b = gd.TokenBucket(rpm=2, tpm=10**6, orologio=oro, dormi=oro.dormi)
+    b.acquisisci(1)
+    b.acquisisci(1)
+    assert b.acquisisci(1) == pytest.approx(30.0, abs=0.05), "2 RPM → una richiesta ogni 30 s"
+
+
+def test_richiesta_oltre_il_tpm_non_blocca_per_sempre():
+    oro = _Orologio()
+    b = gd.TokenBucket(rpm=100, tpm=1000, orologio=oro, dormi=oro.dormi)
+    assert b.acquisisci(50_000) == 0.0
+
+
+def test_backoff_429_condiviso_con_retry_after(monkeypatch):
+    exc = SimpleNamespace(status_code=429, response=SimpleNamespace(headers={"retry-after": "3"}))
+    assert gd.e_rate_limit(exc)
+    assert gd.segnala_429(exc) == 3.0
+    dormite = []
+    assert gd.attendi_backoff(dormi=dormite.append) == pytest.approx(3.0, abs=0.1)
+
+    # Un altro processo vede la stessa scadenza dal file.
+    monkeypatch.setattr(gd, "_pausa_fino_a", 0.0)
+    assert gd.attendi_backoff(dormi=dormite.append) == pytest.approx(3.0, abs=0.1)
+
+
+def test_backoff_429_esponenziale_senza_header():
+    class RateLimitError(Exception):
+        pass
+
+    assert gd.e_rate_limit(RateLimitError())
+    assert [gd.segnala_429(RateLimitError()) for _ in range(3)] == [2.0, 4.0, 8.0]
+    gd.segnala_successo()
+    assert gd.segnala_429() == 2.0
+
+
+def test_dimensiona_batch():
+    corte = [f"ART {i}" for i in range(120)]
+    assert [len(b) for b in gd.dimensiona_batch(corte, max_articoli=50)] == [50, 50, 20]
+    # max_tokens 600 → 15 articoli di risposta per batch.
+    assert {len(b) for b in gd.dimensiona_batch(corte[:30], max_articoli=50, max_token_risposta=600)} == {15}
+    lunghe = ["X" * 900] * 10
+    batch = gd.dimensiona_batch(lunghe, max_articoli=50, budget_token_input=1000)
+    assert [len(b) for b in batch] == [3, 3, 3, 1]
+    assert sum(batch, []) == lunghe, "ordine e contenuto preservati"
+
+
+def test_esegui_in_parallelo_in_ordine_di_completamento():
+    cv = contextvars.ContextVar("cv", default=None)
+    cv.set("tenant-1")
+    in_volo, massimo, lock = [0], [0], threading.Lock()
+
+    def lavoro(x):
+        with lock:
+            in_volo[0] += 1
+            massimo[0] = max(massimo[0], in_volo[0])
+        time.sleep(0.05 * (3 - x))
+        with lock:
+            in_volo[0] -= 1
+        if x == 1:
+            raise RuntimeError("batch rotto")
+        return x, cv.get()
+
+    esiti = list(gd.esegui_in_parallelo([0, 1, 2], lavoro, concorrenza=3))
+    assert [e[0] for e in esiti] == [2, 1, 0], "il piu' veloce arriva per primo"
+    assert esiti[0][1] == (2, "tenant-1"), "ContextVar propagata al thread"
+    assert isinstance(esiti[1][2], RuntimeError) and esiti[1][1] is None
+    assert massimo[0] == 3
+
+
+def test_primo_da_solo_e_concorrenza_uno():
+    ordine = []
+
+    def lavoro(x):
+        ordine.append(("inizio", x))
+        time.sleep(0.01)
+        ordine.append(("fine", x))
+        return x
+
+    list(gd.esegui_in_parallelo([0, 1, 2], lavoro, concorrenza=3, primo_da_solo=True))
+    assert ordine[:2] == [("inizio", 0), ("fine", 0)], "il primo finisce prima che partano gli altri"
+    assert [e[1] for e in gd.esegui_in_parallelo([5, 6], lambda x: x, concorrenza=1)] == [5, 6]
@@ -0,0 +1,127 @@
+"""Viste di catena su 15+ sedi: letture batchate, fan-out limitato, snapshot.
+
+Le letture per sede (override modalità mensile, costi per categoria dal cubo)
+si fanno in una query per tutto il gruppo; quelle che non si batchano vanno con
+un pool limitato (utils/fan_out). La risposta assemblata resta in cache finché
+la versione dati delle sedi non cambia: una scrittura su una sede la invalida.
+"""
+import threading
+import time
+from types import SimpleNamespace
+from unittest.mock import MagicMock, patch
+
+import services.fastapi_worker as fw
+import services.routers.gruppo as gruppo
+from services import costi_cubo
+from utils.fan_out import in_parallelo
+
+_IDS = [f"r{i}" for i in range(1, 16)]
+
+
+class _Query:
+    def __init__(self, rows, chiamate):
+        self._rows = rows
+        chiamate.append(self)
+
+    def select(self, *_a, **_k):
+        return self
+
+    def in_(self, field, values):
+        self._rows = [r for r in self._rows if r.get(field) in values]
+        return self
+
+    def eq(self, field, value):
+        self._rows = [r for r in self._rows if r.get(field) == value]
+        return self
+
+    def order(self, *_a, **_k):
+        return self
+
+    def range(self, *_a, **_k):
+        return self
+
+    def execute(self):
+        return SimpleNamespace(data=self._rows)
+
+
+def test_override_mensili_di_tutte_le_sedi_in_una_query():
+    righe = [
+        {"ristorante_id": "r2", "anno": 2026, "mese": 3, "modalita": "mensile",
+         "fatturato_iva10": 1000.0, "fatturato_iva22": 0, "altri_ricavi_noiva": 0, "coperti": 80},
+        {"ristorante_id": "r5", "anno": 2026, "mese": 3, "modalita": "giornaliera",
+         "fatturato_iva10": 999.0, "fatturato_iva22": 0, "altri_ricavi_noiva": 0, "coperti": 1},
+    ]
+    chiamate = []
+    sb = MagicMock()
+    sb.table.side_effect = lambda _t: _Query(righe, chiamate)
+
+    out = gruppo._overrides_mese_sedi(sb, _IDS, 2026)
+
+    assert len(chiamate) == 1
+    assert set(out) == set(_IDS)
+    assert out["r2"] == {3: {"iva10": 1000.0, "iva22": 0.0, "altri": 0.0, "coperti": 80}}
+    assert out["r5"] == {}, "solo la modalità mensile"
+
+
+def test_costi_per_categoria_un_cubo_per_tutto_il_gruppo():
+    celle = [
+        {"ristorante_id": rid, "anno": 2026, "mese": 2, "categoria": "CARNE",
+         "fonte": costi_cubo.FONTE_FATTURA, "totale": 10.0 * i, "totale_positivo": 10.0 * i, "n_righe": 1}
+        for i, rid in enumerate(_IDS, start=1)
+    ]
+    with patch.object(costi_cubo, "leggi_mensile", return_value=celle) as m_cubo, \
+         patch.object(fw, "_fb_per_categoria_e_mese_da_righe") as m_righe:
+        out = fw._load_fatture_fb_per_categoria_e_mese_sedi(MagicMock(), _IDS, "2026-01-01", "2026-02-28")
+    assert m_cubo.call_count == 1 and m_cubo.call_args.args[0] == _IDS
+    assert m_righe.call_count == 0, "mesi interi: niente righe fattura"
+    assert out["r3"] == {(2026, 2, "CARNE"): 30.0}
+
+
+def test_cubo_giu_ricade_sulle_righe_per_ogni_sede():
+    with patch.object(costi_cubo, "leggi_mensile", side_effect=RuntimeError("cubo giu'")), \
+         patch.object(fw, "_fb_per_categoria_e_mese_da_righe",
+                      side_effect=lambda _sb, rid, _da, _a: {(2026, 1, "PESCE"): float(rid[1:])}) as m_righe:
+        out = fw._load_fatture_fb_per_categoria_e_mese_sedi(MagicMock(), _IDS, "2026-01-01", "2026-01-31")
+    assert m_righe.call_count == len(_IDS)
+    assert out["r7"] == {(2026, 1, "PESCE"): 7.0}
+
+
+def test_fan_out_limitato_e_in_ordine():
+    in_volo, picco = [0], [0]
+    lock = threading.Lock()
+
+    def lento(x):
+        with lock:
+            in_volo[0] += 1
+            picco[0] = max(picco[0], in_volo[0])
+        time.sleep(0.01)
+        with lock:
+            in_volo[0] -= 1
+        return x * 2
+
+    assert in_parallelo(lento, range(20), concorrenza=4) == [x * 2 for x in range(20)]
+    assert 1 < picco[0] <= 4
+
+
+def test_snapshot_finche_la_versione_dati_non_cambia():
+    sedi = [{"id": rid} for rid in _IDS]
+    nomi = {rid: f"Sede {rid}" for rid in _IDS}
+    risposta = MagicMock()
+    with patch.object(gruppo, "_resolve_gruppo", return_value=(MagicMock(), "u1", sedi, "Catena", nomi, _IDS)), \
+         patch.object(gruppo, "_gruppo_margini_coperti_calcola", return_value=risposta) as m_calc:
+        assert gruppo.gruppo_margini_coperti(mese=3, authorization="Bearer t") is risposta
+        gruppo.gruppo_margini_coperti(mese=3, authorization="Bearer t")
+        assert m_calc.call_count == 1
+
+        gruppo.gruppo_margini_coperti(mese=4, authorization="Bearer t")
+        assert m_calc.call_count == 2, "altri parametri, altro snapshot"
+
+        # Un salvataggio su una sede del gruppo (anche da un altro processo, via
+        # cache_bus) alza la versione: lo snapshot non si legge più.
+        fw._invalidate_home_kpi_cache("r9", propaga=False)
+        gruppo.gruppo_margini_coperti(mese=3, authorization="Bearer t")
+        assert m_calc.call_count == 3
+
+        fw._invalidate_fatture_rows_cache("fuori-dal-gruppo", propaga=False)
+        gruppo.gruppo_margini_coperti(mese=3, authorization="Bearer t")
+        assert m_calc.call_count == 3
@@ -49,14 +49,15 @@ def _chiama(anno, mese):
     """Chiama l'endpoint catturando le date passate all'aggregatore fatture."""
     catturate = {}
 
-    def _fake_load(sb, rid, data_da, data_a):
+    def _fake_load(sb, ids, data_da, data_a):
         catturate["data_da"] = data_da
         catturate["data_a"] = data_a
         return {}
 
     fw = SimpleNamespace(
-        _load_fatture_fb_per_categoria_e_mese=_fake_load,
-        _load_mensile_overrides=lambda *a, **k: {},
+        _load_fatture_fb_per_categoria_e_mese_sedi=_fake_load,
+        _load_mensile_overrides_sedi=lambda *a, **k: {},
+        _versione_dati_sedi=lambda ids: (0,),
     )
     sb = _FakeSB({"margini_mensili": []})
 
@@ -0,0 +1,104 @@
+"""/api/home/bundle: le card della Home su un solo contesto per richiesta.
+
+Token e sede si risolvono una volta; le letture comuni alle card (margini
+dell'anno, override mensili, costi automatici, preferenze, inbox) passano da
+_HomeContesto e si fanno una volta sola anche con le card in parallelo. Una
+card lenta o rotta torna None senza affossare le altre.
+"""
+import asyncio
+import contextlib
+import threading
+import time
+from unittest.mock import MagicMock, patch
+
+import pytest
+from fastapi import BackgroundTasks, HTTPException
+
+import services.fastapi_worker as fw
+
+_USER = {"id": "u1", "ultimo_ristorante_id": "r1"}
+
+
+def _sb_vuoto():
+    q = MagicMock()
+    for m in ("select", "eq", "is_", "gte", "or_", "order", "limit"):
+        getattr(q, m).return_value = q
+    q.execute.return_value = MagicMock(data=[], count=0)
+    sb = MagicMock()
+    sb.table.return_value = q
+    return sb
+
+
+def _bundle(card, **patches):
+    async def _run():
+        return await fw.home_bundle(BackgroundTasks(), authorization="Bearer t", card=card)
+
+    with patch.object(fw, "_resolve_user_from_token", return_value=dict(_USER)) as m_user, \
+         patch.object(fw, "_get_async_supabase_client", return_value=MagicMock()), \
+         patch.object(fw, "_get_supabase_client", return_value=_sb_vuoto()), \
+         patch.object(fw, "_oggi_rome", return_value=fw.date(2026, 5, 15)):
+        with patch.multiple(fw, **patches) if patches else contextlib.nullcontext():
+            out = asyncio.run(_run())
+    return out, m_user
+
+
+def test_kpi_e_salute_condividono_le_letture():
+    margini = {4: {"altri_ricavi_noiva": 1000.0, "costo_dipendenti": 300.0}}
+    fw._HOME_KPI_CACHE.invalidate()
+    with patch("services.margine_service.carica_margini_anno", return_value=margini) as m_marg, \
+         patch("services.margine_service.calcola_costi_automatici_per_anno_sql",
+               return_value=({4: 250.0}, {4: 100.0})) as m_costi, \
+         patch.object(fw, "_load_mensile_overrides", return_value={}) as m_ov, \
+         patch.object(fw, "_get_assistant_preferences", return_value={}):
+        out, m_user = _bundle(["kpi", "salute"])
+
+    assert m_user.call_count == 1
+    assert out.kpi.fatturato == 1000.0 and out.kpi.mol == 350.0
+    voci = {v.key: v.ok for v in out.salute.voci}
+    assert voci["fatture"] and voci["fatturato"] and voci["personale"]
+    assert out.briefing is None and out.stats is None
+    # Stesso anno (2026) per entrambe le card: una lettura per fonte.
+    assert m_marg.call_count == 1 and m_costi.call_count == 1 and m_ov.call_count == 1
+    assert margini == {4: {"altri_ricavi_noiva": 1000.0, "costo_dipendenti": 300.0}}, "il KPI lavora su una copia"
+
+
+def test_contesto_single_flight_tra_thread():
+    chiamate = []
+
+    def lento(*_a):
+        chiamate.append(1)
+        time.sleep(0.05)
+        return {1: {"mese": 1}}
+
+    ctx = fw._HomeContesto(dict(_USER), MagicMock(), "r1")
+    with patch("services.margine_service.carica_margini_anno", side_effect=lento):
+        risultati = []
+        threads = [threading.Thread(target=lambda: risultati.append(ctx.margini_anno(2026))) for _ in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+    assert len(chiamate) == 1 and len(risultati) == 4
+
+
+def test_card_lenta_o_rotta_non_affossa_le_altre():
+    def alert_lento(_ctx):
+        time.sleep(0.5)
+        return fw.AlertPrezziResponse(count=0, alerts=[])
+
+    notifiche = fw.NotificheResponse(notifiche=[], total=0, unread=0)
+    with patch.object(fw, "_ALERT_PREZZI_TIMEOUT_SEC", 0.05):
+        out, _ = _bundle(
+            ["alert_prezzi", "salute", "notifiche"],
+            _home_alert_prezzi_calcola=alert_lento,
+            _home_salute_calcola=MagicMock(side_effect=RuntimeError("giu'")),
+            _notifiche_calcola=MagicMock(return_value=notifiche),
+        )
+    assert out.alert_prezzi is None and out.salute is None
+    assert out.notifiche == notifiche
+
+
+def test_card_sconosciuta_400():
+    with pytest.raises(HTTPException) as exc:
+        _bundle(["kpi", "meteo"])
+    assert exc.value.status_code == 400
@@ -43,7 +43,7 @@ def _row(fatturato, mol=None):
 def _call_kpi(margini_per_anno):
     fake_carica, fake_costi = _patch_common(margini_per_anno)
     sb = MagicMock()
-    fw._HOME_KPI_CACHE.clear()
+    fw._HOME_KPI_CACHE.invalidate()
     with patch.object(fw, "_resolve_user_from_token", return_value=_USER), \
          patch.object(fw, "_get_supabase_client", return_value=sb), \
          patch.object(fw, "_resolve_ristorante_id", return_value=_RID), \
@@ -325,18 +325,10 @@ def _run_estrai_xml(xml_bytes, user_id='user_test'):
     Esegue estrai_dati_da_xml su xml_bytes con tutti gli esterni mockati.
     Ritorna la lista di righe estratte.
 
-    Nota: carica_memoria_completa e categorizza_con_memoria vengono importati
+    Nota: carica_memoria_completa e categorizza_batch vengono importati
     dentro la funzione estrai_dati_da_xml (import locale), quindi bisogna
     patchare il namespace sorgente services.ai_service.
-    xmltodict è mockato dal conftest, quindi lo sostituiamo con quello reale.
     """
-    import sys
-    import importlib
-
-    # Rimuovi il mock di xmltodict e carica il modulo reale
-    sys.modules.pop('xmltodict', None)
-    real_xmltodict = importlib.import_module('xmltodict')
-
     from services.invoice_service import estrai_dati_da_xml
 
     file_mock = io.BytesIO(xml_bytes)
@@ -353,10 +345,9 @@ def _run_estrai_xml(xml_bytes, user_id='user_test'):
     mock_st.session_state.get = _session_state_get
 
     with patch('services.invoice_service.st', mock_st), \
-         patch('services.invoice_service.xmltodict', real_xmltodict), \
          patch('services.ai_service.carica_memoria_completa', return_value=None), \
-         patch('services.ai_service.categorizza_con_memoria',
-               return_value=('🧀 LATTICINI E FORMAGGI', False)):
+         patch('services.ai_service.categorizza_batch',
+               side_effect=lambda righe, **kw: [('🧀 LATTICINI E FORMAGGI', False)] * len(righe)):
         return estrai_dati_da_xml(file_mock)
 
 
@@ -455,11 +446,7 @@ class TestGuardrailNoteConImporto:
     coda e fuori dai margini. Regressione del flusso onesto (CLAUDE.md regole #1/#2)."""
 
     def _run_con_categoria_note(self, xml_bytes, user_id='user_test'):
-        """Come _run_estrai_xml ma forza categorizza_con_memoria a restituire NOTE."""
-        import sys
-        import importlib
-        sys.modules.pop('xmltodict', None)
-        real_xmltodict = importlib.import_module('xmltodict')
+        """Come _run_estrai_xml ma forza la categorizzazione a restituire NOTE."""
         from services.invoice_service import estrai_dati_da_xml
 
         file_mock = io.BytesIO(xml_bytes)
@@ -474,10 +461,9 @@ class TestGuardrailNoteConImporto:
         mock_st.session_state.get = _session_state_get
 
         with patch('services.invoice_service.st', mock_st), \
-             patch('services.invoice_service.xmltodict', real_xmltodict), \
              patch('services.ai_service.carica_memoria_completa', return_value=None), \
-             patch('services.ai_service.categorizza_con_memoria',
-                   return_value=('📝 NOTE E DICITURE', False)):
+             patch('services.ai_service.categorizza_batch',
+                   side_effect=lambda righe, **kw: [('📝 NOTE E DICITURE', False)] * len(righe)):
             return estrai_dati_da_xml(file_mock)
 
     def test_note_con_importo_non_resta_servizi(self):
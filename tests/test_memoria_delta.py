@@ -0,0 +1,216 @@
+"""Delta incrementale della memoria di classificazione (ai_service).
+
+Un bump di cache_version dovuto a soli INSERT/UPDATE non deve piu' costare il
+reload completo di prodotti_master/classificazioni_manuali: si scaricano le
+righe con updated_at oltre il watermark e si patchano le mappe in place. Va
+garantito che il risultato sia IDENTICO a quello di un caricamento completo
+(in particolare la mappa canonica, che scarta le chiavi in conflitto) e che
+DELETE, errori e assenza di watermark ripieghino sul reload completo.
+"""
+import time
+from unittest.mock import MagicMock, patch
+
+import pytest
+
+import services.ai_service as ai
+
+
+def _riga_master(desc, cat, conf="alta", streak=0):
+    return {"descrizione": desc, "categoria": cat, "confidence": conf,
+            "consecutive_correct_classifications": streak}
+
+
+def _stato_completo(righe_per_desc):
+    bypass, hint = {}, {}
+    for row in righe_per_desc.values():
+        desc, cat, is_bypass = ai._voce_master(row)
+        (bypass if is_bypass else hint)[desc] = cat
+    canon, _ = ai._build_master_canonical_map(bypass)
+    return bypass, hint, canon
+
+
+def test_patch_master_equivale_al_caricamento_completo():
+    iniziali = {r["descrizione"]: r for r in [
+        _riga_master("MOZZARELLA FIOR DI LATTE 125G", "LATTICINI"),
+        _riga_master("MOZZARELLA FIOR DI LATTE 250G", "LATTICINI"),
+        _riga_master("PANE CASERECCIO", "PRODOTTI DA FORNO", conf="media"),
+        _riga_master("SALMONE AFFUMICATO 100G", "PESCE"),
+        _riga_master("SALMONE AFFUMICATO 200G", "PESCE"),
+    ]}
+    bypass, hint, canon = _stato_completo(iniziali)
+    cache = {"prodotti_master": dict(bypass), "prodotti_master_hint": dict(hint),
+             "prodotti_master_canon": dict(canon)}
+
+    modifiche = [
+        _riga_master("MOZZARELLA FIOR DI LATTE 250G", "SALUMI E FORMAGGI"),   # crea conflitto canonico
+        _riga_master("PANE CASERECCIO", "PRODOTTI DA FORNO", conf="media", streak=3),  # hint → bypass
+        _riga_master("SALMONE AFFUMICATO 200G", "PESCE", conf="media"),       # bypass → hint
+        _riga_master("CAFFE MACINATO 1KG", "CAFFÈ E THE"),                   # nuova
+    ]
+    ai._patch_master(cache, modifiche)
+    finali = dict(iniziali)
+    finali.update({r["descrizione"]: r for r in modifiche})
+    assert (cache["prodotti_master"], cache["prodotti_master_hint"], cache["prodotti_master_canon"]) \
+        == _stato_completo(finali)
+
+    # Il conflitto si risolve: torna la chiave canonica.
+    ripristino = [_riga_master("MOZZARELLA FIOR DI LATTE 250G", "LATTICINI")]
+    ai._patch_master(cache, ripristino)
+    finali.update({r["descrizione"]: r for r in ripristino})
+    assert cache["prodotti_master_canon"] == _stato_completo(finali)[2]
+
+
+def test_fetch_righe_modificate_keyset():
+    pagine = [
+        [{"id": i, "updated_at": "2026-10-17T10:00:00+00:00"} for i in range(ai._PAGE_SIZE)],
+        [{"id": ai._PAGE_SIZE, "updated_at": "2026-10-17T10:00:01+00:00"}],
+    ]
+    query = MagicMock()
+    for metodo in ("select", "gte", "or_", "order", "limit"):
+        getattr(query, metodo).return_value = query
+    query.execute.side_effect = [MagicMock(data=p) for p in pagine]
+    sb = MagicMock()
+    sb.table.return_value = query
+
+    righe = ai._fetch_righe_modificate(sb, "prodotti_master", "id, updated_at", "2026-10-17T09:55:00+00:00")
+    assert len(righe) == ai._PAGE_SIZE + 1
+    query.gte.assert_called_once_with("updated_at", "2026-10-17T09:55:00+00:00")
+    filtro = query.or_.call_args[0][0]
+    assert f"id.gt.{ai._PAGE_SIZE - 1}" in filtro and '"2026-10-17T10:00:00+00:00"' in filtro
+
+
+def _sb_con_versioni(versioni):
+    """Client finto: cache_version risponde con `versioni` (lista mutabile),
+    le altre tabelle passano da _fetch_all_rows/_fetch_righe_modificate patchate."""
+    def table(nome):
+        t = MagicMock()
+        if nome == "cache_version":
+            t.select.return_value.in_.return_value.execute.side_effect = \
+                lambda: MagicMock(data=[dict(r) for r in versioni])
+        else:
+            t.select.return_value.eq.return_value.execute.return_value.data = []
+        return t
+    sb = MagicMock()
+    sb.table.side_effect = table
+    return sb
+
+
+@pytest.fixture
+def stato_remoto():
+    with patch.dict(ai._remote_version_state, {
+        "last_seen_version": 0, "last_seen_delete_version": None,
+        "last_seen_updated_at": None, "last_checked_at": 0.0,
+    }):
+        yield ai._remote_version_state
+
+
+def _carica(sb, stato_remoto, user_id="u1"):
+    stato_remoto["last_checked_at"] = 0.0  # forza il poll di cache_version
+    return ai.carica_memoria_completa(user_id, sb)
+
+
+def test_bump_solo_upsert_applica_delta(stato_remoto):
+    versioni = [
+        {"key": "memoria_classificazione", "version": 10, "updated_at": "2026-10-17T10:00:00+00:00"},
+        {"key": "memoria_classificazione_delete", "version": 3, "updated_at": "2026-10-01T00:00:00+00:00"},
+    ]
+    sb = _sb_con_versioni(versioni)
+    completi = {
+        "prodotti_master": [_riga_master("MOZZARELLA", "LATTICINI")],
+        "classificazioni_manuali": [],
+        "prodotti_utente": [{"descrizione": "OLIO SEMI", "categoria": "OLIO E CONDIMENTI"}],
+    }
+    delta = {
+        "prodotti_master": [_riga_master("BURRATA", "LATTICINI")],
+        "classificazioni_manuali": [{"descrizione": "TRASPORTO", "categoria_corretta": "SERVIZI E CONSULENZE",
+                                     "is_dicitura": False}],
+        "prodotti_utente": [
+            {"user_id": "u1", "descrizione": "OLIO SEMI", "categoria": "VERDURE"},
+            {"user_id": "altro", "descrizione": "X", "categoria": "CARNE"},
+        ],
+    }
+    chiamate_delta = []
+
+    def fake_delta(_sb, table, _select, dal):
+        chiamate_delta.append((table, dal))
+        return delta[table]
+
+    with patch.object(ai, "_fetch_all_rows", side_effect=lambda _sb, t, _s, filters=None: completi[t]) as full, \
+         patch.object(ai, "_fetch_righe_modificate", side_effect=fake_delta):
+        _carica(sb, stato_remoto)
+        assert full.call_count == 3
+        assert ai._memoria_cache["_watermark"] == "2026-10-17T10:00:00+00:00"
+
+        versioni[0].update(version=11, updated_at="2026-10-17T10:05:00+00:00")
+        cache = _carica(sb, stato_remoto)
+        assert full.call_count == 3, "un bump di soli upsert non deve rifare il caricamento completo"
+
+    assert cache["prodotti_master"] == {"MOZZARELLA": "LATTICINI", "BURRATA": "LATTICINI"}
+    assert cache["classificazioni_manuali"]["TRASPORTO"]["categoria"] == "SERVIZI E CONSULENZE"
+    assert cache["prodotti_utente"]["u1"]["OLIO SEMI"] == "VERDURE"
+    assert "altro" not in cache["prodotti_utente"]
+    assert cache["_watermark"] == "2026-10-17T10:05:00+00:00"
+    # Finestra di sovrapposizione sotto il watermark precedente.
+    assert {dal for _, dal in chiamate_delta} == {"2026-10-17T09:55:00+00:00"}
+
+
+def test_bump_con_delete_ricarica_tutto(stato_remoto):
+    versioni = [
+        {"key": "memoria_classificazione", "version": 10, "updated_at": "2026-10-17T10:00:00+00:00"},
+        {"key": "memoria_classificazione_delete", "version": 3, "updated_at": "2026-10-01T00:00:00+00:00"},
+    ]
+    sb = _sb_con_versioni(versioni)
+    with patch.object(ai, "_fetch_all_rows", return_value=[]) as full, \
+         patch.object(ai, "_fetch_righe_modificate") as delta:
+        _carica(sb, stato_remoto)
+        versioni[0]["version"] = 11
+        versioni[1]["version"] = 4
+        _carica(sb, stato_remoto)
+    assert full.call_count == 6
+    delta.assert_not_called()
+
+
+def test_senza_chiave_delete_niente_delta(stato_remoto):
+    """Migration non applicata: comportamento storico (reload completo)."""
+    versioni = [{"key": "memoria_classificazione", "version": 10, "updated_at": "2026-10-17T10:00:00+00:00"}]
+    sb = _sb_con_versioni(versioni)
+    with patch.object(ai, "_fetch_all_rows", return_value=[]) as full, \
+         patch.object(ai, "_fetch_righe_modificate") as delta:
+        _carica(sb, stato_remoto)
+        assert ai._memoria_cache["_watermark"] is None
+        versioni[0]["version"] = 11
+        _carica(sb, stato_remoto)
+    assert full.call_count == 6
+    delta.assert_not_called()
+
+
+def test_delta_fallito_ripiega_su_reload(stato_remoto):
+    versioni = [
+        {"key": "memoria_classificazione", "version": 10, "updated_at": "2026-10-17T10:00:00+00:00"},
+        {"key": "memoria_classificazione_delete", "version": 3, "updated_at": "2026-10-01T00:00:00+00:00"},
+    ]
+    sb = _sb_con_versioni(versioni)
+    with patch.object(ai, "_fetch_all_rows", return_value=[]) as full, \
+         patch.object(ai, "_fetch_righe_modificate", side_effect=RuntimeError("column updated_at does not exist")):
+        _carica(sb, stato_remoto)
+        versioni[0]["version"] = 11
+        _carica(sb, stato_remoto)
+    assert full.call_count == 6
+    assert ai._memoria_cache["loaded"] is True
+
+
+def test_segnala_modifica_senza_watermark_invalida():
+    with patch.dict(ai._memoria_cache, {"loaded": True, "_watermark": None}):
+        versione = ai._memoria_cache["version"]
+        ai._segnala_modifica_memoria()
+    assert ai._memoria_cache["loaded"] is False
+    assert ai._memoria_cache["version"] == versione + 1
+
+
+def test_segnala_modifica_con_watermark_chiede_delta():
+    ai._memoria_cache.update(loaded=True, _watermark="2026-10-17T10:00:00+00:00",
+                             _loaded_at=time.time(), prodotti_master={"A": "CARNE"})
+    ai._segnala_modifica_memoria()
+    assert ai._memoria_cache["loaded"] is True
+    assert ai._memoria_cache["_delta_richiesto"] is True
+    assert ai._memoria_cache["prodotti_master"] == {"A": "CARNE"}
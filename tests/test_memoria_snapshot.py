@@ -0,0 +1,156 @@
+"""Snapshot condiviso della memoria globale (services/memoria_snapshot).
+
+Lo snapshot sostituisce, per i processi dello stesso container, N scansioni di
+prodotti_master/classificazioni_manuali con UNA sola + N mmap in sola lettura.
+Va protetto su tre fronti: i lookup devono essere identici ai dict originali,
+un solo processo deve costruire il file, e un caricamento incompleto non deve
+mai finire su disco (verrebbe servito a tutti fino al TTL).
+"""
+import threading
+import time
+from unittest.mock import MagicMock, patch
+
+import services.ai_service as ai
+from services import memoria_snapshot as ms
+
+_PARTI = {
+    "prodotti_master": {"MOZZARELLA FIOR DI LATTE": "LATTICINI", "CAFFÈ MACINATO": "CAFFÈ E THE", "A": "VERDURE"},
+    "prodotti_master_canon": {"MOZZARELLA": "LATTICINI"},
+    "prodotti_master_hint": {"PANE CASERECCIO": "PRODOTTI DA FORNO"},
+    "classificazioni_manuali": {
+        "TRASPORTO": {"categoria": "📝 NOTE E DICITURE", "is_dicitura": True},
+        "OLIO SEMI": {"categoria": "OLIO E CONDIMENTI", "is_dicitura": False},
+    },
+    "brand_ambigui": {"CONAD", "SELEX"},
+}
+
+
+def test_roundtrip_lookup_identici_ai_dict(tmp_path):
+    path = str(tmp_path / "memoria_v7.snap")
+    ms.scrivi_snapshot(path, 7, _PARTI)
+    parti, built_at = ms.apri_snapshot(path)
+    assert built_at <= time.time()
+    for nome in ms.TABELLE_CATEGORIA + (ms.TABELLA_MANUALI,):
+        assert dict(parti[nome]) == _PARTI[nome]
+        assert len(parti[nome]) == len(_PARTI[nome])
+    assert "CAFFÈ MACINATO" in parti["prodotti_master"]
+    assert "CAFFE MACINATO" not in parti["prodotti_master"]
+    assert parti["prodotti_master"].get("ASSENTE") is None
+    assert parti["prodotti_master"].get(None) is None
+    assert parti["brand_ambigui"] == {"CONAD", "SELEX"}
+    # Il set dei brand resta mutabile per processo (ai_service ci aggiunge al volo).
+    parti["brand_ambigui"].add("NUOVO")
+
+
+def test_tabelle_vuote_sono_falsy(tmp_path):
+    path = str(tmp_path / "memoria_v1.snap")
+    ms.scrivi_snapshot(path, 1, {})
+    parti, _ = ms.apri_snapshot(path)
+    assert not parti["prodotti_master_canon"]
+    assert (parti["prodotti_master_canon"] or {}) == {}
+
+
+def test_snapshot_scaduto_o_corrotto_ignorato(tmp_path):
+    path = str(tmp_path / "memoria_v2.snap")
+    ms.scrivi_snapshot(path, 2, _PARTI, built_at=time.time() - 7200)
+    assert ms.apri_snapshot(path, max_eta_s=3600) is None
+    (tmp_path / "memoria_v3.snap").write_bytes(b"spazzatura")
+    assert ms.apri_snapshot(str(tmp_path / "memoria_v3.snap")) is None
+
+
+def test_un_solo_processo_costruisce(tmp_path):
+    """N chiamanti concorrenti sulla stessa versione: costruisci() gira UNA volta,
+    tutti ottengono gli stessi dati."""
+    chiamate = []
+
+    def costruisci():
+        chiamate.append(1)
+        time.sleep(0.3)
+        return dict(_PARTI), True
+
+    risultati = []
+
+    def worker():
+        risultati.append(ms.carica_o_costruisci(5, costruisci, max_eta_s=3600, directory=str(tmp_path)))
+
+    threads = [threading.Thread(target=worker) for _ in range(5)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert len(chiamate) == 1
+    assert all(r is not None and dict(r[0]["prodotti_master"]) == _PARTI["prodotti_master"] for r in risultati)
+
+
+def test_caricamento_incompleto_non_scritto(tmp_path):
+    out = ms.carica_o_costruisci(9, lambda: ({"prodotti_master": {"X": "CARNE"}}, False),
+                                 max_eta_s=3600, directory=str(tmp_path))
+    assert out[0]["prodotti_master"] == {"X": "CARNE"}
+    assert not (tmp_path / "memoria_v9.snap").exists()
+    assert not (tmp_path / "memoria_v9.snap.lock").exists()
+
+
+def test_lock_altrui_timeout_ritorna_none(tmp_path):
+    (tmp_path / "memoria_v4.snap.lock").write_text("")
+    out = ms.carica_o_costruisci(4, lambda: (dict(_PARTI), True), max_eta_s=3600,
+                                 attesa_s=0.3, directory=str(tmp_path))
+    assert out is None
+
+
+def test_disattivato_senza_env(monkeypatch):
+    monkeypatch.delenv("MEMORIA_SNAPSHOT_DIR", raising=False)
+    assert ms.directory_snapshot() is None
+    assert ms.carica_o_costruisci(1, lambda: ({}, True), max_eta_s=10) is None
+
+
+def test_carica_memoria_completa_usa_snapshot(tmp_path, monkeypatch):
+    """Due 'processi' (due caricamenti a cache invalidata) sulla stessa versione DB:
+    le tabelle globali vengono scaricate una volta sola."""
+    monkeypatch.setenv("MEMORIA_SNAPSHOT_DIR", str(tmp_path))
+    righe = {
+        "prodotti_master": [{"descrizione": "MOZZARELLA", "categoria": "LATTICINI", "confidence": "alta",
+                             "consecutive_correct_classifications": 0}],
+        "classificazioni_manuali": [{"descrizione": "TRASPORTO", "categoria_corretta": "SERVIZI E CONSULENZE",
+                                     "is_dicitura": False}],
+        "prodotti_utente": [],
+    }
+    scaricate = []
+
+    def fake_fetch(_sb, table, _select, filters=None):
+        scaricate.append(table)
+        return righe[table]
+
+    sb = MagicMock()
+    sb.table.return_value.select.return_value.eq.return_value.execute.return_value.data = []
+    with patch.object(ai, "_fetch_all_rows", side_effect=fake_fetch), \
+         patch.dict(ai._remote_version_state, {"last_seen_version": 42, "last_checked_at": time.time()}):
+        ai.carica_memoria_completa("u1", sb)
+        assert ai._memoria_cache["prodotti_master"]["MOZZARELLA"] == "LATTICINI"
+        ai.invalida_cache_memoria()
+        ai.carica_memoria_completa("u1", sb)
+        cache = ai._memoria_cache
+        assert isinstance(cache["prodotti_master"], ms._TabellaMappata)
+        assert cache["prodotti_master"]["MOZZARELLA"] == "LATTICINI"
+        assert cache["classificazioni_manuali"]["TRASPORTO"]["categoria"] == "SERVIZI E CONSULENZE"
+    assert scaricate.count("prodotti_master") == 1
+    assert scaricate.count("classificazioni_manuali") == 1
+    assert (tmp_path / "memoria_v42.snap").exists()
+
+
+def test_overlay_scritture_su_tabella_mappata(tmp_path):
+    """Il delta incrementale patcha le tabelle dello snapshot senza copiarle."""
+    path = str(tmp_path / "memoria_v8.snap")
+    ms.scrivi_snapshot(path, 8, _PARTI)
+    parti, _ = ms.apri_snapshot(path)
+    t = parti["prodotti_master"]
+    t["NUOVA"] = "CARNE"
+    t["A"] = "FRUTTA"
+    del t["MOZZARELLA FIOR DI LATTE"]
+    assert t["NUOVA"] == "CARNE" and t["A"] == "FRUTTA"
+    assert "MOZZARELLA FIOR DI LATTE" not in t
+    assert t.pop("CAFFÈ MACINATO") == "CAFFÈ E THE"
+    assert t.pop("ASSENTE", None) is None
+    atteso = {"A": "FRUTTA", "NUOVA": "CARNE"}
+    assert dict(t) == atteso and len(t) == len(atteso)
+    t["MOZZARELLA FIOR DI LATTE"] = "LATTICINI"
+    assert t["MOZZARELLA FIOR DI LATTE"] == "LATTICINI" and len(t) == 3
@@ -0,0 +1,132 @@
+"""Lettore DER/BER delle buste P7M (services/p7m_der) e cascata di estrai_xml_da_p7m.
+
+Le buste sono costruite a mano con la stessa struttura CMS che producono i
+software di firma (DER a lunghezza definita, BER "streaming" con OCTET STRING a
+chunk e end-of-contents, firma doppia), senza dipendere da openssl nei test.
+"""
+import io
+
+import pytest
+
+from services import invoice_service as inv
+from services import worker_metrics as wm
+from services.p7m_der import estrai_contenuto_p7m
+
+_XML = (
+    '<?xml version="1.0" encoding="UTF-8"?><p:FatturaElettronica xmlns:p="x"><FatturaElettronicaHeader>'
+    '<CedentePrestatore><DatiAnagrafici><IdFiscaleIVA><IdPaese>IT</IdPaese><IdCodice>01234567890</IdCodice>'
+    '</IdFiscaleIVA></DatiAnagrafici></CedentePrestatore></FatturaElettronicaHeader><FatturaElettronicaBody>'
+    + 'CAFFÈ ' * 400 + '</FatturaElettronicaBody></p:FatturaElettronica>'
+).encode('utf-8')
+
+_OID_SIGNED = bytes.fromhex('06092a864886f70d010702')
+_OID_DATA = bytes.fromhex('06092a864886f70d010701')
+
+
+def _tlv(tag, contenuto, indefinita=False):
+    if indefinita:
+        return bytes([tag, 0x80]) + contenuto + b'\x00\x00'
+    n = len(contenuto)
+    if n < 0x80:
+        lun = bytes([n])
+    else:
+        k = (n.bit_length() + 7) // 8
+        lun = bytes([0x80 | k]) + n.to_bytes(k, 'big')
+    return bytes([tag]) + lun + contenuto
+
+
+def _busta(contenuto, ber=False, chunk=1000, detached=False, octet=None):
+    if octet is None and ber:
+        octet = _tlv(0x24, b''.join(_tlv(0x04, contenuto[i:i + chunk])
+                                    for i in range(0, len(contenuto), chunk)), indefinita=True)
+    elif octet is None:
+        octet = _tlv(0x04, contenuto)
+    encap = _OID_DATA + (b'' if detached else _tlv(0xA0, octet, indefinita=ber))
+    firmatari = _tlv(0x31, _tlv(0x30, _tlv(0x02, b'\x01') + b'\x04\x03sig'))
+    signed = (_tlv(0x02, b'\x01') + _tlv(0x31, _tlv(0x30, b'\x06\x03\x60\x86\x48'))
+              + _tlv(0x30, encap, indefinita=ber)
+              + _tlv(0xA0, _tlv(0x30, b'\x02\x01\x05' * 50), indefinita=ber) + firmatari)
+    return _tlv(0x30, _OID_SIGNED + _tlv(0xA0, _tlv(0x30, signed, indefinita=ber), indefinita=ber),
+                indefinita=ber)
+
+
+@pytest.mark.parametrize("ber", [False, True])
+def test_der_e_ber_a_chunk(ber):
+    assert estrai_contenuto_p7m(_busta(_XML, ber=ber)) == _XML
+
+
+def test_chunk_costruiti_annidati():
+    interno = _tlv(0x24, _tlv(0x04, _XML[:10]) + _tlv(0x04, _XML[10:20]), indefinita=True)
+    octet = _tlv(0x24, interno + _tlv(0x04, _XML[20:]))
+    assert estrai_contenuto_p7m(_busta(b'', octet=octet)) == _XML
+
+
+def test_firma_doppia_e_octet_string_incapsulato():
+    assert estrai_contenuto_p7m(_busta(_busta(_XML, ber=True))) == _XML
+    assert estrai_contenuto_p7m(_busta(_tlv(0x04, _XML))) == _XML
+
+
+@pytest.mark.parametrize("contenuto", [
+    b'',
+    b'non e una busta',
+    _busta(_XML)[:300],                       # troncata
+    _busta(_XML, detached=True),              # firma detached: niente contenuto
+    _busta(b'\x00\x01\x02 binario'),          # contenuto che non e' markup
+    _tlv(0x30, _OID_DATA + _tlv(0xA0, _tlv(0x04, _XML))),  # ContentInfo non signedData
+])
+def test_input_non_validi_tornano_none(contenuto):
+    assert estrai_contenuto_p7m(contenuto) is None
+
+
+def _estrai(contenuto, nome='f.xml.p7m'):
+    f = io.BytesIO(contenuto)
+    f.name = nome
+    return inv.estrai_xml_da_p7m(f).read()
+
+
+def test_percorso_caldo_senza_ripieghi_e_telemetria(monkeypatch):
+    wm.reset()
+
+    def _vietato(_b):
+        raise AssertionError("il lettore DER deve bastare")
+
+    monkeypatch.setattr(inv, "_P7M_RIPIEGHI", (("asn1crypto", _vietato),))
+    monkeypatch.setattr(inv, "_estrai_xml_con_openssl", _vietato)
+    assert _estrai(_busta(_XML, ber=True)) == _XML
+    assert wm.p7m_conteggi() == {"der": 1}
+    assert wm.p7m_conteggi("01234567890") == {"der": 1}
+    metodi = wm.snapshot()["p7m"]["metodi"]
+    assert metodi[0]["metodo"] == "der" and metodi[0]["count"] == 1
+
+
+def test_ripieghi_riordinati_per_fornitore(monkeypatch):
+    wm.reset()
+    provati = []
+
+    def _finto(nome, riesce):
+        def f(_b):
+            provati.append(nome)
+            return _XML if riesce else None
+        return f
+
+    monkeypatch.setattr(inv, "_P7M_RIPIEGHI", (
+        ("asn1crypto", _finto("asn1crypto", False)),
+        ("pattern", _finto("pattern", False)),
+        ("der_scan", _finto("der_scan", True)),
+    ))
+    busta_rotta = b'\x31\x00' + _XML  # non e' CMS: il lettore DER rinuncia
+    _estrai(busta_rotta)
+    assert provati == ["asn1crypto", "pattern", "der_scan"]
+    provati.clear()
+    _estrai(busta_rotta)
+    assert provati == ["der_scan"], "il ripiego che ha funzionato per il fornitore va per primo"
+    snap = wm.snapshot()["p7m"]
+    assert snap["fornitori_con_ripiego"] == [{"piva": "01234567890", "metodi": {"der_scan": 2}}]
+
+
+def test_busta_illeggibile_conta_fallimento(monkeypatch):
+    wm.reset()
+    monkeypatch.setattr(inv, "_estrai_xml_con_openssl", lambda _b: None)
+    with pytest.raises(ValueError):
+        _estrai(b'\x30\x03\x02\x01\x01')
+    assert [m["metodo"] for m in wm.snapshot()["p7m"]["metodi"]] == ["fallito"]
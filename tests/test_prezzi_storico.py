@@ -0,0 +1,115 @@
+"""Storico prezzi per coppia prodotto/fornitore (services/prezzi_storico).
+
+La tabella la mantiene il DB; qui si fissano il riepilogo atteso dalle righe
+grezze (stesse regole del trigger), il confronto usato dal controllo di
+coerenza e l'alert prezzi della Home letto dallo storico: stesso risultato
+delle righe fattura, senza caricarle quando il cliente non ha tag.
+"""
+from datetime import date, timedelta
+from unittest.mock import patch
+
+import pandas as pd
+import pytest
+
+from services import prezzi_storico
+from services import price_impact_service as pi
+from services.db_service import calcola_alert
+
+
+def _giorno(fa: int) -> str:
+    return (date.today() - timedelta(days=fa)).isoformat()
+
+
+def _storico(desc, forn, acquisti, categoria="PESCE"):
+    """Riga di prezzi_storico da [(giorni_fa, prezzo, quantita), ...] in ordine cronologico."""
+    return {
+        "descrizione_key": desc.upper(), "fornitore_key": forn.upper(),
+        "descrizione": desc, "fornitore": forn, "categoria": categoria,
+        "n_acquisti": len(acquisti), "ultimi_prezzi": [p for _, p, _ in acquisti],
+        "ultime_date": [_giorno(g) for g, _, _ in acquisti],
+        "ultime_quantita": [q for _, _, q in acquisti], "ultimo_file": f"{desc}.xml",
+    }
+
+
+def test_riepiloga_segue_le_regole_del_trigger():
+    righe = [
+        {"id": i, "descrizione": " salmone", "fornitore": "Ittica", "prezzo_unitario": p,
+         "quantita": 1, "data_documento": f"2026-{m:02d}-01", "tipo_documento": "TD01", "categoria": "PESCE"}
+        for i, (m, p) in enumerate([(1, 10.0), (2, 11.0), (3, 12.0)], start=1)
+    ]
+    righe += [
+        {"id": 9, "descrizione": "SALMONE", "fornitore": "ITTICA", "prezzo_unitario": 5.0,
+         "quantita": 1, "data_documento": "2026-04-01", "tipo_documento": "TD04", "categoria": "PESCE"},
+        {"id": 10, "descrizione": "SALMONE", "fornitore": "ITTICA", "prezzo_unitario": 0,
+         "quantita": 1, "data_documento": "2026-04-01", "tipo_documento": "TD01", "categoria": "PESCE"},
+        # Stessa data del terzo acquisto, id minore: viene prima.
+        {"id": 0, "descrizione": "Salmone", "fornitore": "Ittica", "prezzo_unitario": 9.0,
+         "quantita": 1, "data_documento": "2026-03-01", "tipo_documento": None, "categoria": "CARNE"},
+    ]
+    out = prezzi_storico.riepiloga(righe)
+    assert list(out) == [("SALMONE", "ITTICA")], "note di credito e prezzi nulli esclusi"
+    r = out[("SALMONE", "ITTICA")]
+    assert r["ultimi_prezzi"] == [10.0, 11.0, 9.0, 12.0]
+    assert r["n_acquisti"] == 4 and r["prezzo_medio"] == 10.5
+    assert r["ultima_data"] == "2026-03-01" and r["categoria"] == "PESCE"
+    assert r["frequenza_mensile"] == pytest.approx(4 / (59 / 30))
+
+
+def test_confronta_trova_mancanti_eccessi_e_differenze():
+    attese = {
+        ("A", "X"): {"n_acquisti": 2, "ultimi_prezzi": [1.0, 2.0], "categoria": "PESCE"},
+        ("B", "X"): {"n_acquisti": 1, "ultimi_prezzi": [3.0], "categoria": "CARNE"},
+    }
+    tabella = [
+        {"descrizione_key": "A", "fornitore_key": "X", "n_acquisti": 2, "ultimi_prezzi": [1.0, 2.5], "categoria": "PESCE"},
+        {"descrizione_key": "C", "fornitore_key": "X", "n_acquisti": 1, "ultimi_prezzi": [4.0], "categoria": "CARNE"},
+    ]
+    esito = prezzi_storico.confronta(attese, tabella)
+    assert not esito["coerente"]
+    assert esito["mancanti"] == [["B", "X"]] and esito["in_eccesso"] == [["C", "X"]]
+    assert esito["diverse"] == [{"chiave": ["A", "X"], "campi": ["ultimi_prezzi"]}]
+
+    tabella[0]["ultimi_prezzi"] = [1.0, 2.0000000001]
+    assert prezzi_storico.confronta({("A", "X"): attese[("A", "X")]}, tabella[:1])["coerente"]
+
+
+def test_alert_home_dallo_storico_senza_caricare_le_righe():
+    storico = [
+        _storico("Salmone", "Ittica", [(200, 9.0, 1), (60, 10.0, 2), (40, 10.0, 2), (20, 12.0, 4)]),
+        _storico("Burrata", "Caseificio", [(50, 5.0, 1), (10, 5.5, 1)], categoria="LATTICINI"),
+        _storico("Guanti", "Forniture", [(30, 1.0, 10), (5, 2.0, 10)], categoria="MATERIALE DI CONSUMO"),
+    ]
+    preferiti = {"SALMONE|ITTICA", "GUANTI|FORNITURE"}
+    with patch.object(prezzi_storico, "leggi", return_value=storico) as m_leggi, \
+         patch.object(pi, "carica_e_prepara_dataframe", side_effect=AssertionError("niente righe")), \
+         patch.object(pi, "_leggi_soglia_perc_cliente", return_value=5.0), \
+         patch.object(pi, "_carica_preferiti_keys", return_value=preferiti), \
+         patch.object(pi, "get_custom_tags", return_value=[]):
+        out = pi.calcola_alert_prezzi_impatto("u1", "r1")
+    assert m_leggi.call_args.kwargs["dal"] == _giorno(pi._FINESTRA_GIORNI)
+    assert [a["nome"] for a in out["alerts"]] == ["Salmone"], "burrata non preferita, guanti spese generali"
+
+    # Stesso esito di calcola_alert sulle righe fattura della finestra.
+    df = pd.DataFrame([
+        {"Descrizione": "Salmone", "Fornitore": "Ittica", "Categoria": "PESCE", "PrezzoUnitario": p,
+         "Quantita": q, "DataDocumento": _giorno(g), "FileOrigine": f"f{g}"}
+        for g, p, q in [(60, 10.0, 2), (40, 10.0, 2), (20, 12.0, 4)]
+    ])
+    atteso = calcola_alert(df, soglia_minima=pi._SOGLIA_PERC_CANDIDATO).iloc[0]
+    assert out["top"]["aumento_pct"] == round(float(atteso["Aumento_Perc"]), 1)
+    assert out["top"]["impatto_mese"] == round(float(atteso["Impatto_Stimato"]), 0)
+
+
+def test_storico_non_leggibile_ricade_sulle_righe():
+    df = pd.DataFrame([
+        {"Descrizione": "Salmone", "Fornitore": "Ittica", "Categoria": "PESCE", "PrezzoUnitario": p,
+         "Quantita": 1, "DataDocumento": _giorno(g), "FileOrigine": f"f{g}"}
+        for g, p in [(40, 10.0), (20, 12.0)]
+    ])
+    with patch.object(prezzi_storico, "leggi", side_effect=RuntimeError("relation does not exist")), \
+         patch.object(pi, "carica_e_prepara_dataframe", return_value=df) as m_df, \
+         patch.object(pi, "_leggi_soglia_perc_cliente", return_value=5.0), \
+         patch.object(pi, "_carica_preferiti_keys", return_value={"SALMONE|ITTICA"}), \
+         patch.object(pi, "get_custom_tags", return_value=[]):
+        out = pi.calcola_alert_prezzi_impatto("u1", "r1")
+    assert out["count"] == 1 and m_df.call_count == 1
@@ -60,6 +60,12 @@ class _Query:
     def range(self, _start, _end):
         return self
 
+    def order(self, *_a, **_k):
+        return self
+
+    def limit(self, _n):
+        return self
+
     def execute(self):
         if self._op == "update":
             f, ids = self._in_filter
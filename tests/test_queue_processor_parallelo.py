@@ -0,0 +1,100 @@
+"""Elaborazione parallela degli item claimati in run_cycle.
+
+Sedi diverse vanno in parallelo (il lavoro e' I/O: download XML, Supabase, AI),
+ma gli item della STESSA sede restano sequenziali e nell'ordine di claim. Il
+watchdog JOB_TIMEOUT resta per item: un job bloccato va in retry senza fermare
+le altre corsie.
+"""
+import threading
+import time
+from unittest import mock
+
+import pytest
+
+from worker import queue_processor as qp
+
+
+def _item(qid, sede):
+    return {"id": qid, "event_id": f"ev-{qid}", "user_id": "u1", "ristorante_id": sede}
+
+
+@pytest.fixture
+def ciclo(monkeypatch):
+    """run_cycle con DB finto: registra (sede, id, inizio, fine) di ogni item."""
+    registro = []
+    lock = threading.Lock()
+    fatti = []
+
+    def fake_process(_sb, item, worker_id=None):
+        inizio = time.monotonic()
+        time.sleep(item.get("_durata", 0.2))
+        with lock:
+            registro.append((item["ristorante_id"], item["id"], inizio, time.monotonic()))
+        return qp.ItemResult(queue_id=item["id"], event_id=item["event_id"], status="done", righe=3)
+
+    monkeypatch.setattr(qp, "get_supabase_client", lambda: mock.MagicMock())
+    monkeypatch.setattr(qp, "_release_stale_locks", lambda *_a: 0)
+    monkeypatch.setattr(qp, "_process_item", fake_process)
+    monkeypatch.setattr(qp, "_mark_done", lambda _sb, qid, purge_xml=True: fatti.append(qid))
+
+    def esegui(batch, concurrency=4):
+        monkeypatch.setattr(qp, "_claim_batch", lambda *_a: batch)
+        monkeypatch.setattr(qp, "CONCURRENCY", concurrency)
+        return qp.run_cycle()
+
+    esegui.registro = registro
+    esegui.fatti = fatti
+    return esegui
+
+
+def test_raggruppa_per_tenant_mantiene_ordine_di_claim():
+    batch = [_item(1, "A"), _item(2, "B"), _item(3, "A"), {"id": 4, "event_id": "x"}, _item(5, "B")]
+    corsie = qp._raggruppa_per_tenant(batch)
+    assert [[i["id"] for i in c] for c in corsie] == [[1, 3], [2, 5], [4]]
+
+
+def test_sedi_diverse_in_parallelo_stessa_sede_in_sequenza(ciclo):
+    batch = [_item(1, "A"), _item(2, "B"), _item(3, "C"), _item(4, "A"), _item(5, "B"), _item(6, "C")]
+    t0 = time.monotonic()
+    stats = ciclo(batch)
+    durata = time.monotonic() - t0
+
+    assert stats.done == 6 and stats.rows == 18
+    assert stats.concurrency == 3
+    assert sorted(ciclo.fatti) == [1, 2, 3, 4, 5, 6]
+    assert durata < 6 * 0.2 * 0.75, "gli item di sedi diverse devono sovrapporsi"
+
+    for sede in "ABC":
+        corsia = sorted((r for r in ciclo.registro if r[0] == sede), key=lambda r: r[2])
+        assert [r[1] for r in corsia] == sorted(r[1] for r in corsia), "ordine di claim per sede"
+        assert corsia[0][3] <= corsia[1][2], "stessa sede: mai due item insieme"
+
+
+def test_concurrency_1_resta_sequenziale(ciclo):
+    batch = [_item(1, "A"), _item(2, "B"), _item(3, "C")]
+    stats = ciclo(batch, concurrency=1)
+    ordinati = sorted(ciclo.registro, key=lambda r: r[2])
+    assert [r[1] for r in ordinati] == [1, 2, 3]
+    assert all(a[3] <= b[2] for a, b in zip(ordinati, ordinati[1:]))
+    assert stats.concurrency == 1
+
+
+def test_timeout_per_item_non_blocca_le_altre_corsie(ciclo, monkeypatch):
+    retry = []
+    monkeypatch.setattr(qp, "JOB_TIMEOUT", 0.3)
+    monkeypatch.setattr(qp, "_schedule_retry", lambda _sb, qid, msg: retry.append((qid, msg)))
+    lento = dict(_item(1, "A"), _durata=1.0)
+    stats = ciclo([lento, _item(2, "B"), _item(3, "B")])
+    assert retry == [(1, "job timeout after 0.3s")]
+    assert stats.retry_scheduled == 1 and stats.done == 2
+    assert sorted(ciclo.fatti) == [2, 3]
+
+
+def test_throughput_nel_ciclo(ciclo):
+    stats = ciclo([_item(1, "A"), _item(2, "B")])
+    assert stats.elapsed_s > 0
+    assert len(stats.item_seconds) == 2
+    assert stats.items_per_minute == pytest.approx(2 * 60 / stats.elapsed_s)
+    assert stats.rows_per_second == pytest.approx(6 / stats.elapsed_s)
+    assert 0.5 < stats.pool_utilization <= 1.0
+    stats.log_summary()
@@ -0,0 +1,91 @@
+"""Sveglia event-driven del queue-worker (services/queue_wakeup).
+
+Il server gira davvero (porta effimera su 127.0.0.1) e il client vero lo
+sveglia: e' lo stesso percorso delle Edge Function e degli endpoint FastAPI.
+Va garantito che una sveglia autenticata sblocchi subito il loop, che una
+non autenticata o verso una coda sconosciuta non lo sblocchi, e che il client
+senza configurazione non faccia nulla.
+"""
+import threading
+import time
+import urllib.error
+import urllib.request
+
+import pytest
+
+from services import queue_wakeup as qw
+
+_CHIAVE = "chiave-di-test-abbastanza-lunga"
+
+
+@pytest.fixture
+def server():
+    canale = qw.CanaleSveglia()
+    srv = qw.avvia_server_sveglia(canale, 0, _CHIAVE, host="127.0.0.1")
+    url = f"http://127.0.0.1:{srv.server_address[1]}"
+    yield canale, url
+    srv.shutdown()
+    srv.server_close()
+
+
+def test_sveglia_sblocca_attendi(server):
+    canale, url = server
+    svegliate = []
+    t0 = time.monotonic()
+    waiter = threading.Thread(target=lambda: svegliate.append(canale.attendi(10)))
+    waiter.start()
+    time.sleep(0.05)
+    assert qw.sveglia_queue_worker("fatture", url=url, chiave=_CHIAVE) is True
+    waiter.join(5)
+    assert svegliate == [{"fatture"}]
+    assert time.monotonic() - t0 < 2, "la sveglia deve arrivare ben prima del timeout"
+
+
+def test_sveglie_multiple_si_fondono(server):
+    canale, url = server
+    for coda in ("fatture", "fatture", "email"):
+        assert qw.sveglia_queue_worker(coda, url=url, chiave=_CHIAVE)
+    assert canale.attendi(1) == {"fatture", "email"}
+    assert canale.attendi(0.05) == set()
+
+
+def test_chiave_errata_401_nessuna_sveglia(server):
+    canale, url = server
+    req = urllib.request.Request(f"{url}/sveglia/fatture", data=b"", method="POST",
+                                 headers={"X-Worker-Key": "sbagliata"})
+    with pytest.raises(urllib.error.HTTPError) as exc:
+        urllib.request.urlopen(req, timeout=2)
+    assert exc.value.code == 401
+    assert qw.sveglia_queue_worker("fatture", url=url, chiave="sbagliata") is False
+    assert canale.attendi(0.05) == set()
+
+
+def test_coda_sconosciuta_404(server):
+    canale, url = server
+    req = urllib.request.Request(f"{url}/sveglia/altro", data=b"", method="POST",
+                                 headers={"X-Worker-Key": _CHIAVE})
+    with pytest.raises(urllib.error.HTTPError) as exc:
+        urllib.request.urlopen(req, timeout=2)
+    assert exc.value.code == 404
+    assert canale.attendi(0.05) == set()
+
+
+def test_attendi_timeout_ritorna_vuoto():
+    t0 = time.monotonic()
+    assert qw.CanaleSveglia().attendi(0.1) == set()
+    assert time.monotonic() - t0 >= 0.09
+
+
+def test_client_senza_url_non_fa_nulla(monkeypatch):
+    monkeypatch.delenv("QUEUE_WORKER_WAKEUP_URL", raising=False)
+    assert qw.sveglia_queue_worker("fatture") is False
+    qw.sveglia_queue_worker_async("fatture")  # no-op, nessun thread
+
+
+def test_worker_irraggiungibile_non_solleva():
+    assert qw.sveglia_queue_worker("email", url="http://127.0.0.1:9", chiave=_CHIAVE) is False
+
+
+def test_server_senza_chiave_non_parte():
+    with pytest.raises(ValueError):
+        qw.avvia_server_sveglia(qw.CanaleSveglia(), 0, "")
@@ -315,13 +315,13 @@ _CAMPI_RICAVO = re.compile(
 )
 
 # Quattro modi legittimi di rispettare la regola. I due wrapper esistono davvero
-# (`_merge_override_mensile` in fastapi_worker, `_overrides_mese_sede` in
+# (`_merge_override_mensile` in fastapi_worker, `_overrides_mese_sedi` in
 # gruppo.py) e senza di loro i loro chiamanti sarebbero falsi positivi.
 # `ricavi_modalita_mensile` copre chi interroga la fonte direttamente
 # (gruppo.py:1642): la guardia premia il RISULTATO giusto, non il nome della
 # funzione chiamata.
 _APPLICA_OVERRIDE = re.compile(
-    r'_load_mensile_overrides|_merge_override_mensile|_overrides_mese_sede'
+    r'_load_mensile_overrides|_merge_override_mensile|_overrides_mese_sedi'
     r'|ricavi_modalita_mensile'
 )
 
@@ -347,7 +347,7 @@ _ECCEZIONI_OVERRIDE = {
     # Definizione dell'override stesso e suoi wrapper.
     "_load_mensile_overrides": "è la funzione che implementa la regola",
     "_merge_override_mensile": "wrapper della regola",
-    "_overrides_mese_sede": "wrapper della regola",
+    "_overrides_mese_sedi": "wrapper della regola",
     # Segnale "margine in calo" (gruppo.py:1579, dentro _calcola_segnali): filtra
     # su `fatturato_netto` ma il valore che usa è `mol_perc`. L'override fornisce i
     # ricavi, non un MOL ricalcolato: includere quei mesi mostrerebbe una
@@ -438,19 +438,21 @@ def test_letture_ricavi_da_margini_mensili_applicano_override(sorgente: Path) ->
         f"senza fondere l'override della modalità mensile. Per questi clienti "
         f"margini_mensili è a 0 e il fatturato vero sta in "
         f"ricavi_modalita_mensile. Usa _load_mensile_overrides (o i wrapper "
-        f"_merge_override_mensile / _overrides_mese_sede).\n  - "
+        f"_merge_override_mensile / _overrides_mese_sedi).\n  - "
         + "\n  - ".join(violazioni)
     )
 
 
-def test_load_mensile_overrides_filtra_la_modalita_mensile() -> None:
+@pytest.mark.parametrize("funzione", ["_load_mensile_overrides", "_load_mensile_overrides_sedi"])
+def test_load_mensile_overrides_filtra_la_modalita_mensile(funzione: str) -> None:
     """Se l'override smettesse di filtrare `modalita='mensile'`, applicherebbe
-    valori anche ai clienti che inseriscono i ricavi giorno per giorno."""
+    valori anche ai clienti che inseriscono i ricavi giorno per giorno. Vale
+    anche per la variante multi-sede delle viste di catena."""
     sorgente = _leggi(ROOT / "services" / "fastapi_worker.py")
-    corpo = sorgente.split("def _load_mensile_overrides", 1)[1][:900]
+    corpo = sorgente.split(f"def {funzione}(", 1)[1][:1200]
     assert 'table("ricavi_modalita_mensile")' in corpo
     assert 'eq("modalita", "mensile")' in corpo, (
-        "_load_mensile_overrides non filtra più modalita='mensile': applicherebbe "
+        f"{funzione} non filtra più modalita='mensile': applicherebbe "
         "l'override anche a chi registra i ricavi giornalieri."
     )
 
@@ -0,0 +1,109 @@
+"""Cache righe di analisi in forma colonnare (utils/righe_colonnari).
+
+Due garanzie: le righe rimaterializzate sono IDENTICHE a quelle messe in cache
+(tipi, None, chiavi assenti, ordine), e in Fatture tipo_prodotti/search sono
+maschere sulla stessa voce del periodo, non nuove letture da PostgREST.
+"""
+from unittest.mock import patch
+
+import numpy as np
+
+import services.fastapi_worker as fw
+from utils.righe_colonnari import RigheColonnari
+
+
+_RIGHE = [
+    {"id": 3, "descrizione": "MOZZARELLA", "categoria": "LATTICINI", "quantita": 2,
+     "prezzo_unitario": 4.5, "needs_review": False, "data_documento": "2026-03-02"},
+    {"id": 2, "descrizione": "CARTA FORNO", "categoria": None, "quantita": 1.5,
+     "prezzo_unitario": None, "needs_review": True, "data_documento": None},
+    {"id": -1, "descrizione": "AFFITTO (quota gruppo)", "categoria": "AFFITTI", "quantita": None,
+     "prezzo_unitario": 1200, "needs_review": False, "data_documento": "2026-03-01",
+     "ripartita_su_gruppo": True, "meta": {"riparto_id": "r9"}},
+]
+
+
+def test_roundtrip_identico():
+    st = RigheColonnari.da_righe(_RIGHE)
+    out = st.righe()
+    assert out == _RIGHE
+    assert [type(r["quantita"]) for r in out] == [float, float, type(None)]
+    assert type(out[0]["id"]) is int and out[1]["needs_review"] is True
+    assert "ripartita_su_gruppo" not in out[0], "le chiavi assenti restano assenti"
+    assert out[2]["meta"] == {"riparto_id": "r9"}
+
+
+def test_dict_nuovi_a_ogni_chiamata():
+    st = RigheColonnari.da_righe(_RIGHE)
+    st.righe()[0]["categoria"] = "SPORCATA"
+    assert st.righe()[0]["categoria"] == "LATTICINI"
+
+
+def test_maschere_sui_valori_distinti():
+    st = RigheColonnari.da_righe(_RIGHE * 1000)
+    visti = []
+
+    def pred(v):
+        visti.append(v)
+        return (v or "") in {"LATTICINI", ""}
+
+    m = st.maschera("categoria", pred)
+    assert len(visti) == 3, "il predicato gira una volta per valore distinto"
+    sel = st.righe(m)
+    assert len(sel) == 2000 and {r["id"] for r in sel} == {3, 2}
+    assert st.righe(m & st.maschera("ripartita_su_gruppo", bool)) == []
+    assert st.righe(np.zeros(len(st), dtype=bool)) == []
+
+
+def test_vuoto():
+    st = RigheColonnari.da_righe([])
+    assert len(st) == 0 and st.righe() == [] and st.righe(st.tutte()) == []
+
+
+def test_occupazione_molto_sotto_i_dict():
+    righe = [{"id": i, "descrizione": f"ARTICOLO {i % 500}", "fornitore": f"FORN {i % 40}",
+              "categoria": "PESCE", "totale_riga": i * 1.5} for i in range(20000)]
+    st = RigheColonnari.da_righe(righe)
+    assert st.nbytes() < 20000 * 40
+
+
+class _Query:
+    def __init__(self, righe, letture):
+        self._righe = righe
+        self._letture = letture
+
+    def __getattr__(self, _nome):
+        return lambda *_a, **_k: self
+
+    def execute(self):
+        self._letture.append(1)
+        return type("R", (), {"data": [dict(r) for r in self._righe]})()
+
+
+def test_fatture_tipo_e_search_filtrano_in_locale():
+    righe = [
+        {"id": 5, "descrizione": "Salmone affumicato", "fornitore": "ITTICA", "categoria": "PESCE",
+         "data_documento": "2026-03-05"},
+        {"id": 4, "descrizione": "Energia elettrica", "fornitore": "ENEL", "categoria": "UTENZE E LOCALI",
+         "data_documento": "2026-03-04"},
+        {"id": 3, "descrizione": "Trasporto", "fornitore": "ITTICA", "categoria": "📝 NOTE E DICITURE",
+         "data_documento": "2026-03-03"},
+        {"id": 2, "descrizione": "Salsa_rosa", "fornitore": "CONAD", "categoria": "SALSE E CREME",
+         "data_documento": None},
+    ]
+    letture = []
+    sb = type("SB", (), {"table": lambda _s, _n: _Query(righe, letture)})()
+    with patch.object(fw, "_ristorante_quote_meta", return_value=(None, False)), \
+         patch.object(fw, "CATEGORIE_SPESE_GENERALI_WORKER", {"UTENZE E LOCALI"}):
+        tutte = fw._fetch_fatture_rows(sb, "r1", "2026-03-01", "2026-03-31")
+        food = fw._fetch_fatture_rows(sb, "r1", "2026-03-01", "2026-03-31", "food_beverage")
+        spese = fw._fetch_fatture_rows(sb, "r1", "2026-03-01", "2026-03-31", "spese_generali")
+        ittica = fw._fetch_fatture_rows(sb, "r1", "2026-03-01", "2026-03-31", None, "ittica")
+        jolly = fw._fetch_fatture_rows(sb, "r1", "2026-03-01", "2026-03-31", "food_beverage", "sal%e")
+
+    assert len(letture) == 1, "search e tipo_prodotti non devono rileggere il periodo"
+    assert [r["id"] for r in tutte] == [2, 5, 4], "note escluse, data NULL prima come in Postgres"
+    assert [r["id"] for r in food] == [2, 5]
+    assert [r["id"] for r in spese] == [4]
+    assert [r["id"] for r in ittica] == [5]
+    assert [r["id"] for r in jolly] == [2, 5], "% e _ restano jolly come nell'ilike"
@@ -115,7 +115,7 @@ class FakeClient:
 @pytest.fixture
 def fake():
     c = FakeClient()
-    ss._LAST_SEEN_THROTTLE.clear()
+    ss._LAST_SEEN_THROTTLE.invalidate()
     return c
 
 
@@ -0,0 +1,112 @@
+"""Token di accesso firmati (services/session_token).
+
+Il token si verifica senza I/O: i test controllano firma, scadenza, revoche
+(locali e sincronizzate da `sessioni`) e che _resolve_user_from_token non
+tocchi Supabase quando riceve un token di accesso.
+"""
+import time
+from datetime import datetime, timezone
+from types import SimpleNamespace
+from unittest.mock import MagicMock, patch
+
+import pytest
+from fastapi import HTTPException
+
+import services
+import services.fastapi_worker as fw
+from services import session_token
+
+_USER = {
+    "id": "u-1", "email": "x@y.it", "nome_ristorante": "Trattoria", "attivo": True,
+    "pagine_abilitate": {"margine": True}, "tema": "dark", "ultimo_ristorante_id": "r-1",
+    "password_hash": "segreto",
+}
+
+
+@pytest.fixture(autouse=True)
+def _chiave(monkeypatch):
+    monkeypatch.setenv("ONEFLUX_ACCESS_TOKEN_KEY", "chiave-di-test")
+    monkeypatch.setenv("ONEFLUX_REVOCHE_SYNC_S", "3600")
+    # Sync appena fatta: la verifica non deve andare a DB durante il test.
+    session_token._sync_stato["ultimo"] = time.monotonic()
+
+
+def test_emissione_e_verifica_locale():
+    token, scadenza = session_token.emetti(_USER, "s-1")
+    assert token.startswith("ofa1.") and scadenza > time.time()
+    user = session_token.verifica(token)
+    assert user["id"] == "u-1" and user["ultimo_ristorante_id"] == "r-1"
+    assert "password_hash" not in user
+
+    corpo, _, firma = token.rpartition(".")
+    assert session_token.verifica(corpo[:-2] + "xx." + firma) is None, "payload alterato"
+    scaduto, _ = session_token.emetti(_USER, "s-1", ttl=-5)
+    assert session_token.verifica(scaduto) is None
+
+
+def test_senza_chiave_disattivato(monkeypatch):
+    monkeypatch.delenv("ONEFLUX_ACCESS_TOKEN_KEY")
+    monkeypatch.delenv("WORKER_SECRET_KEY", raising=False)
+    assert session_token.emetti(_USER, "s-1") is None
+    assert not session_token.abilitato()
+
+
+def test_revoca_vale_solo_per_i_token_gia_emessi():
+    vecchio, _ = session_token.emetti(_USER, "s-1")
+    session_token.revoca_utente("u-1", quando=time.time() + 0.01)
+    time.sleep(0.02)
+    nuovo, _ = session_token.emetti(_USER, "s-1")
+    assert session_token.verifica(vecchio) is None
+    assert session_token.verifica(nuovo) is not None
+
+    session_token.revoca_sid("s-1", quando=time.time() + 1)
+    assert session_token.verifica(nuovo) is None
+
+
+def test_sync_revoche_da_sessioni():
+    token, _ = session_token.emetti(_USER, "s-9")
+    adesso = datetime.now(timezone.utc).isoformat()
+    sb = MagicMock()
+    q = sb.table.return_value.select.return_value.or_.return_value
+    q.execute.return_value = SimpleNamespace(data=[{"id": "s-9", "revoked_at": None, "access_non_prima_di": adesso}])
+    assert session_token.sincronizza_revoche(sb) == 1
+    assert session_token.verifica(token) is None
+    filtro = sb.table.return_value.select.return_value.or_.call_args[0][0]
+    assert filtro.startswith("revoked_at.gte.") and "+" not in filtro
+
+
+def test_resolve_user_con_token_di_accesso_non_fa_query(monkeypatch):
+    sb = MagicMock()
+    monkeypatch.setattr(fw, "_get_supabase_client", lambda: sb)
+    monkeypatch.setattr(services, "get_supabase_client", lambda: sb)
+    token, _ = session_token.emetti(_USER, "s-1")
+
+    user = fw._resolve_user_from_token(f"Bearer {token}")
+    assert user["ultimo_ristorante_id"] == "r-1"
+    sb.table.assert_not_called()
+    assert token not in fw._SEDE_ATTIVA_CACHE
+
+    session_token.revoca_sid("s-1", quando=time.time() + 1)
+    with pytest.raises(HTTPException) as exc:
+        fw._resolve_user_from_token(f"Bearer {token}")
+    assert exc.value.status_code == 401
+
+
+def test_endpoint_emette_solo_per_sessioni_della_tabella():
+    sb = MagicMock()
+    sb.table.return_value.select.return_value.eq.return_value.eq.return_value.execute.return_value = \
+        SimpleNamespace(data=[dict(_USER)])
+    with patch.object(fw, "_get_supabase_client", return_value=sb), \
+         patch("services.session_service.sessione_attiva", return_value={"id": "s-1", "user_id": "u-1"}), \
+         patch("services.session_service.tocca_sessione") as m_tocca:
+        out = fw.auth_access_token(authorization="Bearer sess-token")
+    assert session_token.verifica(out.access_token)["id"] == "u-1"
+    assert 0 < out.expires_in <= session_token.ttl_secondi()
+    m_tocca.assert_called_once()
+
+    with patch.object(fw, "_get_supabase_client", return_value=sb), \
+         patch("services.session_service.sessione_attiva", return_value=None):
+        with pytest.raises(HTTPException) as exc:
+            fw.auth_access_token(authorization="Bearer token-legacy")
+    assert exc.value.status_code == 404
+
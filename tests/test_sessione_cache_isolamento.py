@@ -12,7 +12,6 @@ il primo popola la cache, il secondo pretende di NON vedere quel valore. Se la
 fixture `_reset_worker_caches` smette di svuotare `_SESSIONE_CACHE`, il secondo
 diventa rosso.
 """
-import time
 
 import services.ai_service as ai_service
 import services.auth_service as auth_service
@@ -23,10 +22,7 @@ _UTENTE_DEL_PRIMO_TEST = {"id": "utente-A", "email": "a@oneflux.it"}
 
 
 def test_a_popola_la_cache_di_sessione():
-    auth_service._SESSIONE_CACHE[_TOKEN] = (
-        time.time() + auth_service._SESSIONE_CACHE_TTL,
-        dict(_UTENTE_DEL_PRIMO_TEST),
-    )
+    auth_service._SESSIONE_CACHE.set(_TOKEN, dict(_UTENTE_DEL_PRIMO_TEST))
     assert auth_service._SESSIONE_CACHE.get(_TOKEN) is not None
 
 
@@ -37,7 +33,7 @@ def test_b_non_eredita_la_sessione_del_test_precedente():
     residuo = auth_service._SESSIONE_CACHE.get(_TOKEN)
     assert residuo is None, (
         "_SESSIONE_CACHE non e' stata svuotata fra i test: l'utente "
-        f"{residuo[1] if residuo else None} e' sopravvissuto al test precedente. "
+        f"{residuo} e' sopravvissuto al test precedente. "
         "Un test successivo leggerebbe questa sessione senza mai interrogare il DB."
     )
 
@@ -0,0 +1,167 @@
+"""Client PostgREST async (services/supabase_async) e fetch_all_async.
+
+Il server PostgREST e' un httpx.MockTransport: si verifica la richiesta HTTP
+che esce davvero (parametri, header), non una catena di mock.
+"""
+import asyncio
+import logging
+
+import httpx
+import pytest
+
+from services import supabase_async as sa
+from utils.supabase_paging import fetch_all_async
+
+
+def _client(handler):
+    return sa.AsyncPostgrest("https://x.supabase.co", "chiave", transport=httpx.MockTransport(handler))
+
+
+def _run(coro):
+    return asyncio.run(coro)
+
+
+def test_filtri_e_header_come_supabase_py():
+    visti = []
+
+    def handler(request):
+        visti.append(request)
+        return httpx.Response(200, json=[{"id": 1}], headers={"content-range": "0-0/42"})
+
+    async def go():
+        sb = _client(handler)
+        q = (
+            sb.table("fatture").select("id, categoria", count="exact")
+            .eq("ristorante_id", "r1").is_("deleted_at", "null")
+            .not_.is_("data_documento", "null")
+            .in_("fornitore", ["ADC", "ROSSI, BIANCHI & C."])
+            .gte("data_documento", "2026-01-01").eq("attivo", True)
+            .order("data_documento", desc=True).order("id")
+            .range(0, 99)
+        )
+        return await q.execute()
+
+    resp = _run(go())
+    assert resp.data == [{"id": 1}] and resp.count == 42
+    req = visti[0]
+    params = dict(req.url.params)
+    assert req.url.path == "/rest/v1/fatture"
+    assert params["select"] == "id,categoria"
+    assert params["ristorante_id"] == "eq.r1"
+    assert params["deleted_at"] == "is.null"
+    assert req.url.params.get_list("data_documento") == ["not.is.null", "gte.2026-01-01"]
+    assert params["fornitore"] == 'in.(ADC,"ROSSI, BIANCHI & C.")'
+    assert params["attivo"] == "eq.true"
+    assert params["order"] == "data_documento.desc,id.asc"
+    assert params["offset"] == "0" and params["limit"] == "100"
+    assert req.headers["prefer"] == "count=exact"
+    assert req.headers["apikey"] == "chiave" and req.headers["authorization"] == "Bearer chiave"
+
+
+def test_builder_immutabile_range_non_accumula():
+    visti = []
+
+    def handler(request):
+        visti.append(request.url.params)
+        return httpx.Response(200, json=[])
+
+    async def go():
+        base = _client(handler).table("t").select("id")
+        await base.range(0, 9).execute()
+        await base.range(10, 19).execute()
+        await base.execute()
+
+    _run(go())
+    assert visti[1].get_list("offset") == ["10"] and visti[1].get_list("limit") == ["10"]
+    assert "offset" not in visti[2]
+
+
+def test_single_rpc_ed_errori():
+    def handler(request):
+        if request.url.path.endswith("/rpc/somma"):
+            import json
+            return httpx.Response(200, json=sum(json.loads(request.content).values()))
+        if request.headers.get("accept") == "application/vnd.pgrst.object+json":
+            return httpx.Response(200, json={"id": "u1"})
+        return httpx.Response(400, json={"code": "42703", "message": "column x does not exist"})
+
+    async def go():
+        sb = _client(handler)
+        singolo = await sb.table("users").select("id").eq("id", "u1").single().execute()
+        somma = await sb.rpc("somma", {"a": 2, "b": 3})
+        with pytest.raises(sa.PostgrestAsyncError) as exc:
+            await sb.table("users").select("x").execute()
+        return singolo, somma, exc.value
+
+    singolo, somma, err = _run(go())
+    assert singolo.data == {"id": "u1"}
+    assert somma.data == 5
+    assert err.status == 400 and err.code == "42703"
+
+
+def test_fetch_all_async_pagina_fino_alla_pagina_corta():
+    dati = [{"id": i} for i in range(2500)]
+
+    def handler(request):
+        off, lim = int(request.url.params["offset"]), int(request.url.params["limit"])
+        return httpx.Response(200, json=dati[off:off + lim])
+
+    righe = _run(fetch_all_async(_client(handler).table("t").select("id")))
+    assert [r["id"] for r in righe] == list(range(2500))
+
+
+def test_fetch_all_async_cap_con_warning(caplog):
+    def handler(request):
+        return httpx.Response(200, json=[{"id": 0}] * int(request.url.params["limit"]))
+
+    with caplog.at_level(logging.WARNING, logger="supabase_paging"):
+        righe = _run(fetch_all_async(_client(handler).table("t").select("id"), page_size=10, max_rows=30))
+    assert len(righe) == 30
+    assert "TRONCATO" in caplog.text
+
+
+def test_un_client_per_event_loop(monkeypatch):
+    monkeypatch.setenv("SUPABASE_URL", "https://x.supabase.co")
+    monkeypatch.setenv("SUPABASE_SERVICE_ROLE_KEY", "chiave")
+
+    async def due_volte():
+        a, b = sa.get_async_client(), sa.get_async_client()
+        assert a is b
+        await sa.chiudi_async_client()
+        return a
+
+    primo = _run(due_volte())
+    secondo = _run(due_volte())
+    assert primo is not secondo
+
+
+def test_senza_configurazione_solleva(monkeypatch):
+    monkeypatch.delenv("SUPABASE_URL", raising=False)
+
+    async def go():
+        sa.get_async_client()
+
+    with pytest.raises(RuntimeError):
+        _run(go())
+
+
+def test_endpoint_categorie_async_vede_oltre_la_millesima_riga(monkeypatch):
+    """/api/fatture/categorie portato ad async: 'Da Classificare' oltre la riga
+    1000 resta visibile (CLAUDE.md §1), come col fetch_all sincrono."""
+    import services.fastapi_worker as fw
+    from services.routers import fatture as rf
+
+    righe = [{"id": i, "categoria": "PESCE"} for i in range(1000)] + [{"id": 1000, "categoria": "Da Classificare"}]
+
+    def handler(request):
+        if request.url.path.endswith("/categorie"):
+            return httpx.Response(200, json=[{"nome": "CARNE"}])
+        dopo = int(request.url.params.get("id", "gt.-1").split(".")[1])
+        lim = int(request.url.params["limit"])
+        return httpx.Response(200, json=[r for r in righe if r["id"] > dopo][:lim])
+
+    monkeypatch.setattr(fw, "_resolve_user_from_token", lambda _a: {"id": "u1", "ultimo_ristorante_id": "r1"})
+    monkeypatch.setattr(fw, "_get_async_supabase_client", lambda: _client(handler))
+    out = _run(rf.get_categorie_disponibili(authorization="Bearer t"))
+    assert "Da Classificare" in out["usate"]
+    assert out["categorie"] == sorted({"PESCE", "Da Classificare", "CARNE"})
@@ -0,0 +1,118 @@
+"""Pagine in parallelo di utils.supabase_paging.fetch_all.
+
+Il fake riproduce la struttura del builder di postgrest-py che fetch_all clona
+(richiesta con QueryParams/Headers httpx, `range()` che ACCUMULA i parametri,
+server che onora l'ultimo valore duplicato) e un server con latenza: si
+verifica che il risultato resti identico al ciclo sequenziale (righe, ordine,
+cap, warning) e che le pagine si sovrappongano davvero.
+"""
+import logging
+import threading
+import time
+
+import httpx
+import pytest
+
+from utils import supabase_paging as sp
+
+
+class _Server:
+    def __init__(self, n, latenza=0.0, count_stantio=None, con_count=True):
+        self.righe = [{"id": i} for i in range(n)]
+        self.latenza = latenza
+        self.count_stantio = count_stantio
+        self.con_count = con_count
+        self.richieste = []
+        self._lock = threading.Lock()
+        self._in_volo = 0
+        self.max_in_volo = 0
+
+    def rispondi(self, req):
+        offset = int(req.params.get_list("offset")[-1])
+        limit = int(req.params.get_list("limit")[-1])
+        with self._lock:
+            self.richieste.append((offset, req.headers.get("Prefer")))
+            self._in_volo += 1
+            self.max_in_volo = max(self.max_in_volo, self._in_volo)
+        time.sleep(self.latenza)
+        with self._lock:
+            self._in_volo -= 1
+        count = None
+        if self.con_count and "count=exact" in (req.headers.get("Prefer") or ""):
+            count = self.count_stantio if self.count_stantio is not None else len(self.righe)
+        return type("R", (), {"data": self.righe[offset:offset + limit], "count": count})()
+
+
+class _Richiesta:
+    def __init__(self, server):
+        self.server = server
+        self.params = httpx.QueryParams({"select": "id", "order": "id.asc"})
+        self.headers = httpx.Headers()
+
+
+class _BuilderReale:
+    def __init__(self, server):
+        self.request = _Richiesta(server)
+
+    def range(self, inizio, fine):
+        self.request.params = self.request.params.add("offset", inizio).add("limit", fine - inizio + 1)
+        return self
+
+    def execute(self):
+        return self.request.server.rispondi(self.request)
+
+
+@pytest.mark.parametrize("n", [0, 1, 999, 1000, 1001, 2500, 10000])
+def test_stesse_righe_e_stesso_ordine_del_sequenziale(n):
+    righe = sp.fetch_all(_BuilderReale(_Server(n)), concorrenza=4)
+    assert [r["id"] for r in righe] == list(range(n))
+
+
+def test_pagine_in_parallelo_con_pool_limitato():
+    srv = _Server(10_000, latenza=0.05)
+    t0 = time.monotonic()
+    righe = sp.fetch_all(_BuilderReale(srv), concorrenza=4)
+    durata = time.monotonic() - t0
+    assert len(righe) == 10_000
+    assert srv.max_in_volo == 4
+    # Sequenziale: 10 x 0.05s. In parallelo: 1 + ceil(9/4) = 4 giri.
+    assert durata < 10 * 0.05 * 0.7
+
+
+def test_solo_la_prima_pagina_chiede_il_conteggio_e_il_builder_resta_intatto():
+    srv = _Server(3000)
+    builder = _BuilderReale(srv)
+    sp.fetch_all(builder, concorrenza=4)
+    assert srv.richieste[0] == (0, "count=exact")
+    assert all(prefer is None for _, prefer in srv.richieste[1:])
+    assert "offset" not in builder.request.params
+    assert "Prefer" not in builder.request.headers
+
+
+def test_cap_max_rows_con_warning(caplog):
+    srv = _Server(10_000)
+    with caplog.at_level(logging.WARNING, logger="supabase_paging"):
+        righe = sp.fetch_all(_BuilderReale(srv), max_rows=3000, concorrenza=4)
+    assert [r["id"] for r in righe] == list(range(3000))
+    assert "TRONCATO" in caplog.text
+    assert max(o for o, _ in srv.richieste) < 3000
+
+
+def test_righe_arrivate_dopo_il_conteggio_non_si_perdono():
+    srv = _Server(3500, count_stantio=2000)
+    righe = sp.fetch_all(_BuilderReale(srv), concorrenza=4)
+    assert [r["id"] for r in righe] == list(range(3500))
+
+
+def test_senza_conteggio_ripiega_sul_sequenziale():
+    srv = _Server(2500, latenza=0.01, con_count=False)
+    righe = sp.fetch_all(_BuilderReale(srv), concorrenza=4)
+    assert len(righe) == 2500
+    assert srv.max_in_volo == 1
+
+
+def test_concorrenza_1_resta_sequenziale():
+    srv = _Server(3000, latenza=0.01)
+    assert len(sp.fetch_all(_BuilderReale(srv), concorrenza=1)) == 3000
+    assert srv.max_in_volo == 1
+    assert all(prefer is None for _, prefer in srv.richieste)
@@ -0,0 +1,137 @@
+"""Paginazione keyset di utils.supabase_paging (fetch_all_keyset / _async).
+
+Il motivo per cui esiste: con l'offset, un INSERT o un DELETE concorrente fra
+due pagine sposta le righe e la scansione ne ripete o ne salta qualcuna. Il
+fake tiene una tabella in memoria, applica davvero i filtri del cursore e
+permette di modificarla fra una pagina e l'altra.
+"""
+import asyncio
+import logging
+
+import httpx
+
+from services.supabase_async import AsyncPostgrest
+from utils import supabase_paging as sp
+
+
+class _Tabella:
+    def __init__(self, n):
+        self.righe = [{"id": i, "tenant": "t1"} for i in range(n)]
+        self.pagine = 0
+        self.dopo_pagina = None  # callback(numero_pagina) fra una pagina e l'altra
+
+
+class _Query:
+    """Builder MUTABILE come quello di supabase-py: ogni pagina ne vuole uno nuovo."""
+
+    def __init__(self, tabella):
+        self.t = tabella
+        self.filtri = []
+        self.ordini = []
+        self.n = None
+
+    def eq(self, col, val):
+        self.filtri.append(lambda r: r[col] == val)
+        return self
+
+    def gt(self, col, val):
+        self.filtri.append(lambda r: r[col] > val)
+        return self
+
+    def lt(self, col, val):
+        self.filtri.append(lambda r: r[col] < val)
+        return self
+
+    def order(self, col, desc=False):
+        self.ordini.append((col, desc))
+        return self
+
+    def limit(self, n):
+        self.n = n
+        return self
+
+    def execute(self):
+        assert len(self.ordini) == 1, "order() accumulato: builder riusato fra le pagine"
+        col, desc = self.ordini[0]
+        righe = sorted((r for r in self.t.righe if all(f(r) for f in self.filtri)),
+                       key=lambda r: r[col], reverse=desc)[: self.n]
+        self.t.pagine += 1
+        if self.t.dopo_pagina:
+            self.t.dopo_pagina(self.t.pagine)
+
+        class _R:
+            data = [dict(r) for r in righe]
+        return _R()
+
+
+def test_scansione_completa_e_pagina_corta_finale():
+    t = _Tabella(2500)
+    rows = sp.fetch_all_keyset(lambda: _Query(t).eq("tenant", "t1"), page_size=1000)
+    assert [r["id"] for r in rows] == list(range(2500))
+    assert t.pagine == 3
+
+
+def test_multiplo_esatto_chiude_con_pagina_vuota():
+    t = _Tabella(2000)
+    assert len(sp.fetch_all_keyset(lambda: _Query(t), page_size=1000)) == 2000
+    assert t.pagine == 3
+
+
+def test_insert_e_delete_concorrenti_non_duplicano_ne_saltano():
+    """A meta' scansione si cancellano righe gia' lette e se ne inseriscono di
+    nuove: con l'offset la pagina successiva slitterebbe; col cursore no."""
+    t = _Tabella(300)
+
+    def scrittore(pagina):
+        if pagina == 1:
+            del t.righe[:50]                                  # righe gia' lette
+            t.righe.extend({"id": 1000 + i, "tenant": "t1"} for i in range(5))
+
+    t.dopo_pagina = scrittore
+    ids = [r["id"] for r in sp.fetch_all_keyset(lambda: _Query(t), page_size=100)]
+    assert len(ids) == len(set(ids))
+    assert ids == list(range(300)) + [1000 + i for i in range(5)]
+
+
+def test_ordine_decrescente():
+    t = _Tabella(250)
+    rows = sp.fetch_all_keyset(lambda: _Query(t), chiavi=(("id", True),), page_size=100)
+    assert [r["id"] for r in rows] == list(range(249, -1, -1))
+
+
+def test_cap_tronca_con_warning(caplog):
+    t = _Tabella(500)
+    with caplog.at_level(logging.WARNING, logger="supabase_paging"):
+        rows = sp.fetch_all_keyset(lambda: _Query(t), page_size=100, max_rows=200)
+    assert len(rows) == 200
+    assert "TRONCATO" in caplog.text
+
+
+def test_filtro_composto_per_tupla():
+    class _Q:
+        def or_(self, filtro):
+            self.filtro = filtro
+            return self
+
+    q = sp._dopo(_Q(), (("data_documento", True), ("id", True)), {"data_documento": "2026-03-01", "id": 42})
+    assert q.filtro == 'data_documento.lt."2026-03-01",and(data_documento.eq."2026-03-01",id.lt.42)'
+    assert sp._letterale('a"b') == '"a\\"b"'
+
+
+def test_async_sul_client_vero():
+    righe = [{"id": i} for i in range(1500)]
+    viste = []
+
+    def handler(request):
+        params = request.url.params
+        viste.append(dict(params))
+        dopo = int(params.get("id", "gt.-1").split(".", 1)[1])
+        lim = int(params["limit"])
+        return httpx.Response(200, json=[r for r in righe if r["id"] > dopo][:lim])
+
+    sb = AsyncPostgrest("https://x.supabase.co", "k", transport=httpx.MockTransport(handler))
+    base = sb.table("fatture").select("id").eq("ristorante_id", "r1")
+    rows = asyncio.run(sp.fetch_all_keyset_async(lambda: base, page_size=1000))
+    assert [r["id"] for r in rows] == list(range(1500))
+    assert viste[0]["order"] == "id.asc" and "offset" not in viste[0] and "id" not in viste[0]
+    assert viste[1]["id"] == "gt.999" and viste[1]["ristorante_id"] == "eq.r1"
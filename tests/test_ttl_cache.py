@@ -67,3 +67,57 @@ def test_chiavi_diverse_non_si_bloccano():
     c = TTLCache(ttl=5.0)
     assert c.get_or_set("a", lambda: 1) == 1
     assert c.get_or_set("b", lambda: 2) == 2
+
+
+def test_lru_per_numero_di_voci():
+    c = TTLCache(ttl=10.0, max_entries=2)
+    c.set("a", 1)
+    c.set("b", 2)
+    assert c.get("a") == 1          # "a" torna la piu' recente
+    c.set("c", 3)
+    assert c.get("b") is None and c.get("a") == 1 and c.get("c") == 3
+    assert c.stats()["evictions"] == 1
+
+
+def test_tetto_in_byte_con_stima():
+    c = TTLCache(ttl=10.0, max_bytes=20_000)
+    c.set("piccola", "x" * 100)
+    c.set("grande", ["y" * 1000] * 30)   # ~30 KB stimati: oltre il tetto da sola
+    assert c.get("grande") is None, "una voce oltre il tetto non resta in cache"
+    assert c.get("piccola") is None, "ne' lascia spazio alle altre"
+    c.set("media", ["z" * 1000] * 5)
+    assert c.get("media") is not None
+    assert 5000 < c.stats()["bytes_stimati"] <= 20_000
+
+
+def test_sweep_e_contatori():
+    c = TTLCache(ttl=0.05, nome="test_sweep_e_contatori")
+    c.set("a", 1)
+    c.set("b", 2, ttl=10.0)
+    assert c.get("a") == 1 and c.get("zz") is None
+    time.sleep(0.1)
+    assert c.sweep() == 1
+    assert c.keys() == ["b"]
+    s = c.stats()
+    assert (s["hit"], s["miss"], s["scadute"], s["voci"]) == (1, 1, 1, 1)
+    from utils.ttl_cache import statistiche
+    assert any(x["nome"] == "test_sweep_e_contatori" for x in statistiche())
+
+
+def test_invalidate_where_e_default_per_valori_none():
+    c = TTLCache(ttl=10.0)
+    c.set("r1::a", 1)
+    c.set("r10::a", 2)
+    c.set("r2::a", None)
+    assert c.invalidate_where(lambda k: k.startswith("r1::")) == 1
+    assert c.keys() == ["r10::a", "r2::a"]
+    manca = object()
+    assert c.get("r2::a", manca) is None, "None in cache non e' un miss"
+    assert c.get("r9::a", manca) is manca
+
+
+def test_single_flight_non_accumula_lock_per_chiave():
+    c = TTLCache(ttl=10.0)
+    for i in range(100):
+        c.get_or_set(f"k{i}", lambda: "v")
+    assert c._flight_locks == {}
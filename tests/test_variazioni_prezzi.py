@@ -0,0 +1,91 @@
+"""Motore vettoriale delle variazioni prezzo (services/variazioni_prezzi).
+
+Le metriche per gruppo (ultimo/penultimo, trend, frequenze, medie) si calcolano
+a segmenti su un frame ordinato una volta sola: i test fissano i valori sui
+casi che il vecchio ciclo per gruppo trattava a parte (stagionale, prezzi a
+zero, oscillazioni) e che variazioni e score fornitori dello stesso periodo
+condividano un solo riepilogo.
+"""
+from unittest.mock import MagicMock, patch
+
+import pandas as pd
+
+from services import variazioni_prezzi
+from services.db_service import calcola_alert
+from services.routers import prezzi
+
+
+def _riga(desc, forn, prezzo, data, qta=1.0, **extra):
+    return {
+        "descrizione": desc, "fornitore": forn, "categoria": "CARNE",
+        "prezzo_unitario": prezzo, "quantita": qta, "totale_riga": prezzo * qta,
+        "data_documento": data, "file_origine": f"{desc}-{data}.xml", "tipo_documento": "TD01",
+        **extra,
+    }
+
+
+def test_riepilogo_per_gruppo():
+    righe = [
+        _riga("Salmone", "Ittica", 10.0, "2026-01-10", qta=2),
+        _riga("salmone ", "ITTICA", 11.0, "2026-02-10", qta=4),
+        _riga("SALMONE", "ittica", 12.0, "2026-03-10", qta=6),
+        _riga("SALMONE", "Ittica", 13.0, "2026-04-10", qta=8),
+        _riga("Aglio", "Orto", 1.0, "2026-01-01"),
+    ]
+    base = prezzi._prepara_variazioni(righe)
+    assert len(base.gruppi) == 1, "un solo acquisto di aglio: nessun confronto"
+    g = base.gruppi.iloc[0]
+    assert (g["prezzo_pen"], g["prezzo_ult"]) == (12.0, 13.0)
+    assert g["trend"] == variazioni_prezzi.TREND_SALITA_FORTE
+    assert g["media_tutti"] == 11.5 and g["qta_media_ult3"] == 6.0
+    assert g["freq_intervalli"] == 1.0, "un acquisto al mese"
+    assert g["freq_periodo"] == 4 / 3
+
+
+def test_variazioni_oltre_soglia_con_storico_e_stagionale():
+    righe = [
+        _riga("Burrata", "Caseificio", 5.0, "2025-06-01"),
+        _riga("Burrata", "Caseificio", 6.0, "2026-01-15"),
+        _riga("Pane", "Forno", 2.0, "2026-01-01"),
+        _riga("Pane", "Forno", 2.02, "2026-01-08"),
+    ]
+    out = prezzi._calcola_variazioni_prezzi_sync(righe, soglia=5.0)
+    assert [v["prodotto"] for v in out] == ["Burrata ⚠️ >6m"]
+    v = out[0]
+    assert v["storico"] == "€5.00 → €6.00" and v["trend"] == "⬆" and v["aumento_perc"] == 20.0
+
+
+def test_calcola_alert_usa_il_prodotto_prevalente_anche_sugli_omaggi():
+    df = pd.DataFrame([
+        {"Descrizione": "Olio EVO", "Fornitore": "Frantoio", "Categoria": "OLIO",
+         "PrezzoUnitario": 8.0, "Quantita": 1, "DataDocumento": "2026-01-01", "FileOrigine": "a"},
+        {"Descrizione": "OLIO EVO", "Fornitore": "Frantoio", "Categoria": "OLIO",
+         "PrezzoUnitario": 0.0, "Quantita": 1, "DataDocumento": "2026-01-05", "FileOrigine": "b"},
+        {"Descrizione": "OLIO EVO", "Fornitore": "Frantoio", "Categoria": "OLIO",
+         "PrezzoUnitario": 10.0, "Quantita": 3, "DataDocumento": "2026-01-11", "FileOrigine": "c"},
+    ])
+    out = calcola_alert(df, soglia_minima=5.0)
+    assert out.loc[0, "Prodotto"] == "OLIO EVO"
+    assert out.loc[0, "Aumento_Perc"] == 25.0
+    # Intervallo di 10 giorni -> 3 acquisti/mese; quantita' media delle ultime 2.
+    assert out.loc[0, "Impatto_Stimato"] == 2.0 * 2.0 * 3.0
+
+
+def test_variazioni_e_score_condividono_il_riepilogo():
+    righe = [_riga("Manzo", "Carni", p, f"2026-0{i + 1}-01") for i, p in enumerate([10.0, 11.0, 13.0])]
+    user = {"id": "u1"}
+    with patch.multiple(
+        prezzi,
+        _resolve_user_from_token=MagicMock(return_value=user),
+        _get_supabase_client=MagicMock(return_value=MagicMock()),
+        _resolve_ristorante_id=MagicMock(return_value="r1"),
+        _carica_preferiti_keys=MagicMock(return_value=set()),
+        _nc_credito_per_fornitore=MagicMock(return_value={}),
+    ), patch.object(prezzi, "_prepara_variazioni", wraps=prezzi._prepara_variazioni) as spia, \
+            patch.object(prezzi, "_load_fatture_for_prezzi", return_value=righe):
+        var = prezzi.get_variazioni_prezzi("2026-01-01", "2026-12-31", soglia=5.0, authorization="Bearer t")
+        prezzi.get_score_fornitori("2026-01-01", "2026-12-31", soglia=5.0, authorization="Bearer t")
+        prezzi._invalidate_prezzi_rows_cache("r1")
+        prezzi.get_variazioni_prezzi("2026-01-01", "2026-12-31", soglia=5.0, authorization="Bearer t")
+    assert var.variazioni[0].aumento_perc == round(2 / 11 * 100, 2)
+    assert spia.call_count == 2, "score riusa il riepilogo; l'invalidazione lo ricalcola"
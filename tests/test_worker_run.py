@@ -52,6 +52,9 @@ class _FakeCycleStats:
 
 
 class _FakeEmailStats:
+    def __init__(self, claimed=0):
+        self.claimed = claimed
+
     def log_summary(self):
         pass
 
@@ -235,6 +238,88 @@ def test_main_sleep_1s_quando_batch_claimed(worker_run_module, monkeypatch):
     assert sleep_calls == [1]
 
 
+# ─── main() — sveglia event-driven (services/queue_wakeup) ──────────────────
+
+class _FakeCanale:
+    """Canale di sveglia finto: restituisce le code in `risposte`, poi esce."""
+
+    def __init__(self, risposte):
+        self.risposte = list(risposte)
+        self.timeouts = []
+
+    def attendi(self, timeout):
+        self.timeouts.append(timeout)
+        if not self.risposte:
+            raise _StopLoop()
+        return set(self.risposte.pop(0))
+
+
+def test_main_sveglia_serve_solo_la_coda_svegliata(worker_run_module, monkeypatch):
+    monkeypatch.setenv("WORKER_WAKEUP_FALLBACK_POLL_SECONDS", "60")
+    run_cycle_mock = MagicMock(return_value=_FakeCycleStats(batch_claimed=0))
+    email_cycle_mock = MagicMock(return_value=_FakeEmailStats())
+    modules_patch, *_ = _patch_main_deps(worker_run_module, run_cycle_mock, email_cycle_mock)
+    canale = _FakeCanale([{"email"}, set()])
+
+    worker_run_module = _reload_worker_run()
+    with patch.dict(sys.modules, modules_patch), \
+         patch.object(worker_run_module, "_avvia_sveglia", return_value=canale), \
+         patch.object(time_module, "sleep", side_effect=AssertionError("con la sveglia niente sleep")):
+        with pytest.raises(_StopLoop):
+            worker_run_module.main()
+
+    # Giro 1: entrambe le code. Giro 2: svegliata solo 'email'. Giro 3: timeout
+    # del polling di sicurezza → di nuovo entrambe.
+    assert run_cycle_mock.call_count == 2
+    assert email_cycle_mock.call_count == 3
+    assert canale.timeouts == [60, 60, 60]
+
+
+def test_main_sveglia_batch_pieno_ripassa_subito(worker_run_module, monkeypatch):
+    run_cycle_mock = MagicMock(return_value=_FakeCycleStats(batch_claimed=5))
+    modules_patch, *_ = _patch_main_deps(worker_run_module, run_cycle_mock)
+    canale = _FakeCanale([{"email"}])
+
+    worker_run_module = _reload_worker_run()
+    with patch.dict(sys.modules, modules_patch), \
+         patch.object(worker_run_module, "_avvia_sveglia", return_value=canale):
+        with pytest.raises(_StopLoop):
+            worker_run_module.main()
+
+    # Arretrato fatture: attesa di 1s e la coda fatture resta servita anche se
+    # la sveglia riguardava solo le email.
+    assert canale.timeouts == [1, 1]
+    assert run_cycle_mock.call_count == 2
+
+
+def test_main_sveglia_arretrato_email_ripassa_subito(worker_run_module, monkeypatch):
+    monkeypatch.setenv("WORKER_WAKEUP_FALLBACK_POLL_SECONDS", "60")
+    run_cycle_mock = MagicMock(return_value=_FakeCycleStats(batch_claimed=0))
+    email_cycle_mock = MagicMock(return_value=_FakeEmailStats(claimed=4))
+    modules_patch, *_ = _patch_main_deps(worker_run_module, run_cycle_mock, email_cycle_mock)
+    canale = _FakeCanale([set()])
+
+    worker_run_module = _reload_worker_run()
+    with patch.dict(sys.modules, modules_patch), \
+         patch.object(worker_run_module, "_avvia_sveglia", return_value=canale):
+        with pytest.raises(_StopLoop):
+            worker_run_module.main()
+
+    # Arretrato email: niente attesa del polling di sicurezza da 60s.
+    assert canale.timeouts == [1, 1]
+
+
+def test_avvia_sveglia_senza_porta_resta_sul_polling(worker_run_module, monkeypatch):
+    monkeypatch.delenv("WORKER_WAKEUP_PORT", raising=False)
+    assert worker_run_module._avvia_sveglia() is None
+
+
+def test_avvia_sveglia_senza_chiave_resta_sul_polling(worker_run_module, monkeypatch):
+    monkeypatch.setenv("WORKER_WAKEUP_PORT", "0")
+    monkeypatch.delenv("WORKER_SECRET_KEY", raising=False)
+    assert worker_run_module._avvia_sveglia() is None
+
+
 # ─── main() — backoff esponenziale con jitter ──────────────────────────────
 
 def test_main_backoff_esponenziale_cresce_e_si_cappa(worker_run_module, monkeypatch):
@@ -0,0 +1,45 @@
+"""Fan-out concorrente e LIMITATO di letture indipendenti (una per sede).
+
+Le viste di catena mettono insieme dati per sede. La regola e' batchare: una
+query `in_("ristorante_id", ids)` o una RPC di gruppo al posto di N letture. Ma
+alcune letture non si batchano (proiezione quote di gruppo per PV, fallback
+per-sede quando una RPC di gruppo non risponde): in sequenza costano N volte la
+latenza di un round-trip, e con 15+ sedi la finestra ci mette secondi ad aprirsi.
+
+`in_parallelo` le esegue con un pool piccolo e limitato, come le pagine di
+`utils/supabase_paging.fetch_all`: PostgREST/pgbouncer sono condivisi con gli
+altri processi, quindi il fan-out non deve crescere con il numero di sedi.
+Il risultato e' nell'ordine degli elementi, come il ciclo sequenziale.
+"""
+
+from __future__ import annotations
+
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Iterable, List, TypeVar
+
+T = TypeVar("T")
+R = TypeVar("R")
+
+# Letture per sede in volo contemporaneamente per una singola chiamata.
+# 1 = comportamento sequenziale storico.
+CONCORRENZA = max(1, int(os.environ.get("FAN_OUT_CONCURRENCY", "6")))
+
+
+def in_parallelo(
+    fn: Callable[[T], R],
+    elementi: Iterable[T],
+    concorrenza: int | None = None,
+    nome: str = "fan-out",
+) -> List[R]:
+    """`[fn(e) for e in elementi]` con al piu' `concorrenza` chiamate in volo.
+
+    Un'eccezione di `fn` si propaga al chiamante come nel ciclo sequenziale:
+    chi vuole il best-effort per sede la gestisce dentro `fn`.
+    """
+    lista = list(elementi)
+    conc = CONCORRENZA if concorrenza is None else max(1, int(concorrenza))
+    if conc == 1 or len(lista) <= 1:
+        return [fn(e) for e in lista]
+    with ThreadPoolExecutor(max_workers=min(conc, len(lista)), thread_name_prefix=nome) as pool:
+        return list(pool.map(fn, lista))
@@ -0,0 +1,122 @@
+"""Automa Aho-Corasick per il match di molte keyword in una sola passata.
+
+Nasce per `ai_service.applica_correzioni_dizionario`: il dizionario
+`DIZIONARIO_CORREZIONI` ha oltre mille keyword e prima ognuna era una regex
+compilata provata con `re.search` in sequenza. Su una descrizione che NON
+matcha nulla (il caso piu' frequente nelle fatture GDO) si pagavano migliaia di
+ricerche per riga. L'automa scorre la stringa UNA volta e trova tutte le
+occorrenze di tutte le keyword insieme.
+
+Semantica identica ai pattern regex che sostituisce:
+
+    (?:^|[\\s\\W\\d])KEYWORD(?:[\\s\\W]|$)
+
+cioe' bordo sinistro = inizio stringa, carattere non-parola O cifra (per i
+codici GDO tipo "200CANGURINO"); bordo destro = fine stringa o carattere
+non-parola. I bordi sono verificati con le STESSE classi `re` (Unicode), non
+con `str.isalnum()`, per non divergere sui caratteri accentati.
+
+La priorita' e' il RANGO: la keyword in posizione i della lista passata al
+costruttore batte tutte quelle dopo. `miglior_rango` ritorna il rango minimo fra
+le occorrenze valide — esattamente il primo pattern che `re.search` avrebbe
+trovato scorrendo la lista in ordine.
+
+Uso:
+    from utils.keyword_automaton import KeywordAutomaton
+
+    automa = KeywordAutomaton(["MOZZARELLA", "MOZZ", "VASC"])
+    automa.miglior_rango(" MOZZARELLA VASC 1KG ")   # -> 0
+"""
+
+from __future__ import annotations
+
+import re
+from collections import deque
+from typing import Dict, Iterable, List, Optional, Tuple
+
+_BORDO_SINISTRO = re.compile(r'[\s\W\d]')
+_BORDO_DESTRO = re.compile(r'[\s\W]')
+
+
+class KeywordAutomaton:
+    """Automa immutabile costruito una volta; `miglior_rango` e' thread-safe
+    (nessuno stato mutabile condiviso durante la ricerca)."""
+
+    __slots__ = ("_goto", "_fail", "_out", "_n_keyword")
+
+    def __init__(self, keywords: Iterable[str]) -> None:
+        goto: List[Dict[str, int]] = [{}]
+        out: List[List[Tuple[int, int]]] = [[]]
+        n = 0
+        for rango, kw in enumerate(keywords):
+            n += 1
+            if not kw:
+                continue
+            stato = 0
+            for ch in kw:
+                nxt = goto[stato].get(ch)
+                if nxt is None:
+                    nxt = len(goto)
+                    goto[stato][ch] = nxt
+                    goto.append({})
+                    out.append([])
+                stato = nxt
+            # Keyword duplicate: conta solo il rango migliore (il primo), come
+            # farebbe la scansione lineare che si ferma al primo match.
+            if not any(lung == len(kw) for _r, lung in out[stato]):
+                out[stato].append((rango, len(kw)))
+
+        # BFS per i link di fallimento; le uscite di ogni stato ereditano quelle
+        # del suo stato di fallimento (suffissi che sono a loro volta keyword).
+        fail = [0] * len(goto)
+        coda: deque = deque()
+        for nxt in goto[0].values():
+            coda.append(nxt)
+        while coda:
+            stato = coda.popleft()
+            for ch, nxt in goto[stato].items():
+                coda.append(nxt)
+                f = fail[stato]
+                while f and ch not in goto[f]:
+                    f = fail[f]
+                fail[nxt] = goto[f].get(ch, 0)
+                out[nxt] = out[nxt] + out[fail[nxt]]
+
+        self._goto = goto
+        self._fail = fail
+        # Ordinate per rango: in ricerca ci si ferma alla prima uscita che non
+        # migliora il rango gia' trovato.
+        self._out = [tuple(sorted(o)) for o in out]
+        self._n_keyword = n
+
+    def __len__(self) -> int:
+        return self._n_keyword
+
+    def miglior_rango(self, testo: str) -> Optional[int]:
+        """Rango minimo fra le keyword che compaiono in `testo` rispettando i
+        bordi parola; None se nessuna."""
+        goto = self._goto
+        fail = self._fail
+        out = self._out
+        n_testo = len(testo)
+        migliore: Optional[int] = None
+        stato = 0
+        for i, ch in enumerate(testo):
+            while stato and ch not in goto[stato]:
+                stato = fail[stato]
+            stato = goto[stato].get(ch, 0)
+            uscite = out[stato]
+            if not uscite:
+                continue
+            fine = i + 1
+            for rango, lung in uscite:
+                if migliore is not None and rango >= migliore:
+                    break
+                inizio = fine - lung
+                if inizio > 0 and not _BORDO_SINISTRO.match(testo, inizio - 1):
+                    continue
+                if fine < n_testo and not _BORDO_DESTRO.match(testo, fine):
+                    continue
+                migliore = rango
+                break
+        return migliore
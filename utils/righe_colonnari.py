@@ -0,0 +1,191 @@
+"""Righe PostgREST in forma colonnare compressa, per le cache di analisi.
+
+Problema: le cache righe di Fatture (_FATTURE_ROWS_CACHE) e Prezzi
+(_PREZZI_ROWS_CACHE) tenevano liste di dict Python: ~1 KB a riga fra dict,
+chiavi e stringhe, e la STESSA riga ripetuta sotto ogni chiave (search,
+tipo_prodotti). Su una sede da 50.000 righe sono decine di MB per chiave e per
+processo uvicorn.
+
+Qui ogni colonna e' un solo array:
+  - stringhe (e None) → codici int32 + dizionario dei valori distinti: una
+    descrizione/fornitore/categoria/data ripetuta su N righe esiste una volta;
+  - int, float, bool omogenei → array NumPy nativo;
+  - tutto il resto (tipi misti) → lista di oggetti, senza compressione.
+
+I filtri si applicano come maschere booleane: un predicato su una colonna a
+dizionario si valuta sui soli valori DISTINTI (poche centinaia di categorie,
+qualche migliaio di descrizioni) e si proietta sulle righe con un gather
+vettoriale. `righe(maschera)` rimaterializza i dict solo per la risposta: li
+possiede il chiamante, che li puo' modificare senza sporcare la cache.
+
+Le chiavi assenti restano assenti (le righe proiettate di gruppo hanno campi in
+piu' di quelle reali) e l'ordine delle righe e' quello di costruzione.
+"""
+
+from __future__ import annotations
+
+import sys
+from abc import ABC, abstractmethod
+from typing import Any, Callable, Dict, Iterable, List, Optional
+
+import numpy as np
+
+_ASSENTE = object()
+
+
+class _Colonna(ABC):
+    __slots__ = ("assenti",)
+
+    def __init__(self, assenti: Optional[np.ndarray]) -> None:
+        # Maschera delle righe in cui la chiave non c'era (None = presente ovunque).
+        self.assenti = assenti
+
+    @abstractmethod
+    def valori(self, sel: Optional[np.ndarray] = None) -> list:
+        """Valori Python delle righe `sel` (indici), o di tutte."""
+
+    def maschera(self, predicato: Callable[[Any], bool]) -> np.ndarray:
+        return np.fromiter((bool(predicato(v)) for v in self.valori()), dtype=bool)
+
+    def nbytes(self) -> int:
+        return self.assenti.nbytes if self.assenti is not None else 0
+
+
+class _ColonnaDizionario(_Colonna):
+    __slots__ = ("codici", "distinti")
+
+    def __init__(self, valori: list, assenti: Optional[np.ndarray]) -> None:
+        super().__init__(assenti)
+        indice: Dict[Any, int] = {}
+        self.codici = np.fromiter(
+            (indice.setdefault(v, len(indice)) for v in valori), dtype=np.int32, count=len(valori),
+        )
+        self.distinti = list(indice)
+
+    def valori(self, sel: Optional[np.ndarray] = None) -> list:
+        distinti = self.distinti
+        codici = self.codici if sel is None else self.codici[sel]
+        return [distinti[c] for c in codici.tolist()]
+
+    def maschera(self, predicato: Callable[[Any], bool]) -> np.ndarray:
+        ok = np.fromiter((bool(predicato(v)) for v in self.distinti), dtype=bool, count=len(self.distinti))
+        return ok[self.codici]
+
+    def nbytes(self) -> int:
+        return (super().nbytes() + self.codici.nbytes
+                + sum(sys.getsizeof(v) for v in self.distinti))
+
+
+class _ColonnaNumerica(_Colonna):
+    __slots__ = ("dati", "nulli")
+
+    def __init__(self, valori: list, dtype, assenti: Optional[np.ndarray]) -> None:
+        super().__init__(assenti)
+        nulli = np.fromiter((v is None for v in valori), dtype=bool, count=len(valori))
+        self.nulli = nulli if nulli.any() else None
+        zero = dtype(0)
+        self.dati = np.array([zero if v is None else v for v in valori], dtype=dtype)
+
+    def valori(self, sel: Optional[np.ndarray] = None) -> list:
+        out = (self.dati if sel is None else self.dati[sel]).tolist()
+        if self.nulli is not None:
+            nulli = self.nulli if sel is None else self.nulli[sel]
+            for i in np.flatnonzero(nulli).tolist():
+                out[i] = None
+        return out
+
+    def nbytes(self) -> int:
+        return super().nbytes() + self.dati.nbytes + (self.nulli.nbytes if self.nulli is not None else 0)
+
+
+class _ColonnaOggetti(_Colonna):
+    __slots__ = ("dati",)
+
+    def __init__(self, valori: list, assenti: Optional[np.ndarray]) -> None:
+        super().__init__(assenti)
+        self.dati = valori
+
+    def valori(self, sel: Optional[np.ndarray] = None) -> list:
+        return list(self.dati) if sel is None else [self.dati[i] for i in sel.tolist()]
+
+    def nbytes(self) -> int:
+        return super().nbytes() + sys.getsizeof(self.dati) + sum(sys.getsizeof(v) for v in self.dati)
+
+
+def _colonna(valori: list) -> _Colonna:
+    assenti_l = [v is _ASSENTE for v in valori]
+    assenti = np.array(assenti_l, dtype=bool) if any(assenti_l) else None
+    if assenti is not None:
+        valori = [None if v is _ASSENTE else v for v in valori]
+    tipi = {type(v) for v in valori if v is not None}
+    if tipi <= {str}:
+        return _ColonnaDizionario(valori, assenti)
+    if tipi == {bool}:
+        return _ColonnaNumerica(valori, np.bool_, assenti)
+    if tipi == {int} and all(-2**63 <= v < 2**63 for v in valori if v is not None):
+        return _ColonnaNumerica(valori, np.int64, assenti)
+    if tipi <= {int, float} and all(abs(v) < 2**53 for v in valori if type(v) is int):
+        # numeric di Postgres arriva come int o float a seconda del valore: i
+        # float64 li rappresentano entrambi senza perdita (interi sotto 2^53).
+        return _ColonnaNumerica(valori, np.float64, assenti)
+    return _ColonnaOggetti(valori, assenti)
+
+
+class RigheColonnari:
+    """Insieme immutabile di righe (dict) memorizzato per colonne."""
+
+    __slots__ = ("_n", "_colonne")
+
+    def __init__(self, n: int, colonne: Dict[str, _Colonna]) -> None:
+        self._n = n
+        self._colonne = colonne
+
+    @classmethod
+    def da_righe(cls, righe: Iterable[Dict[str, Any]]) -> "RigheColonnari":
+        righe = list(righe)
+        nomi: Dict[str, None] = {}
+        for r in righe:
+            for k in r:
+                nomi.setdefault(k, None)
+        return cls(len(righe), {k: _colonna([r.get(k, _ASSENTE) for r in righe]) for k in nomi})
+
+    def __len__(self) -> int:
+        return self._n
+
+    @property
+    def colonne(self) -> List[str]:
+        return list(self._colonne)
+
+    def tutte(self) -> np.ndarray:
+        return np.ones(self._n, dtype=bool)
+
+    def maschera(self, colonna: str, predicato: Callable[[Any], bool]) -> np.ndarray:
+        """Righe in cui `predicato(valore)` e' vero (chiave assente → valore None).
+
+        Sulle colonne a dizionario il predicato gira una volta per valore distinto.
+        """
+        col = self._colonne.get(colonna)
+        if col is None:
+            return np.full(self._n, bool(predicato(None)), dtype=bool)
+        return col.maschera(predicato)
+
+    def righe(self, maschera: Optional[np.ndarray] = None) -> List[Dict[str, Any]]:
+        """Rimaterializza i dict (nuovi a ogni chiamata) delle righe selezionate."""
+        sel = None if maschera is None else np.flatnonzero(maschera)
+        n = self._n if sel is None else len(sel)
+        nomi = list(self._colonne)
+        if not nomi:
+            return [{} for _ in range(n)]
+        colonne = [c.valori(sel) for c in self._colonne.values()]
+        out = [dict(zip(nomi, valori)) for valori in zip(*colonne)]
+        for nome, col in self._colonne.items():
+            if col.assenti is None:
+                continue
+            assenti = col.assenti if sel is None else col.assenti[sel]
+            for j in np.flatnonzero(assenti).tolist():
+                del out[j][nome]
+        return out
+
+    def nbytes(self) -> int:
+        """Stima dell'occupazione in memoria (array + valori distinti)."""
+        return sum(c.nbytes() for c in self._colonne.values())
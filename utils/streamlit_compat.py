@@ -57,13 +57,22 @@ def _cache_key(args, kwargs) -> str:
     )
 
 
+# Una voce per combinazione di argomenti: senza limite, una funzione chiamata
+# con argomenti sempre diversi (date, filtri) cresceva per tutto il processo.
+_MAX_VOCI_PER_FUNZIONE = 1024
+
+
 def make_cache(ttl=None, **_kwargs):
     """Decoratore di cache con TTL. `show_spinner` e simili sono accettati e
     ignorati: erano parametri di presentazione di Streamlit."""
     ttl_seconds = float(ttl) if ttl is not None else 60.0
 
     def _decorator(fn):
-        cache = TTLCache(ttl=ttl_seconds)
+        cache = TTLCache(
+            ttl=ttl_seconds,
+            nome=f"st_cache:{fn.__module__}.{fn.__qualname__}",
+            max_entries=_MAX_VOCI_PER_FUNZIONE,
+        )
 
         @wraps(fn)
         def _wrapped(*args, **kwargs):
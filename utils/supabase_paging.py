@@ -32,6 +32,34 @@ Se un domani si cambia client HTTP o quel comportamento del server, questo e' il
 punto che si rompe per primo — e si romperebbe in silenzio, restituendo dati
 sovrapposti invece di un errore.
 
+Pagine in parallelo: sul builder reale di supabase-py la prima pagina chiede
+anche il conteggio esatto (`Prefer: count=exact`); noto il totale, le pagine
+restanti partono insieme su un pool limitato (SUPABASE_PAGING_CONCURRENCY,
+default 4) invece che una dopo l'altra. Il tempo di `fetch_all` e' quasi tutto
+trasporto (10 round-trip, ~4,3s per la sede piu' grande in Prezzi): in parallelo
+diventa ~1 round-trip + ceil(9/4). Ogni pagina e' una richiesta CLONATA dai
+parametri del builder prima di qualunque `range()` — il builder del chiamante
+non viene toccato, e il problema dei parametri accumulati non si presenta.
+Garanzie invariate: righe nell'ordine delle pagine (quindi dell'`order()` del
+chiamante), stesso cap `MAX_ROWS`, stesso warning di troncamento. Se fra il
+conteggio e le pagine arrivano righe nuove, si prosegue in sequenza dopo
+l'ultima pagina piena, come farebbe il ciclo storico. Builder che non si
+lasciano clonare (fake dei test, mock) usano il ciclo sequenziale.
+
+Per gli endpoint `async def` c'e' `fetch_all_async`, stessa semantica sul
+builder di services/supabase_async (immutabile: li' `range()` sostituisce
+offset/limit invece di accumularli, quindi il punto fragile sopra non si pone).
+
+Scansioni complete: `fetch_all_keyset`. L'offset costa O(n) sul database per
+OGNI pagina (PostgreSQL deve scorrere e scartare le prime `offset` righe), quindi
+leggere un tenant da 50.000 righe a pagine di 1000 e' O(n^2); e se il
+queue-worker scrive a meta' scansione le righe slittano di posizione e una
+pagina ne salta o ne ripete una. Il keyset riparte dall'ultima chiave vista
+(`id > ultimo_id`, o la tupla (data_documento, id) nell'ordine chiesto): ogni
+pagina e' una discesa d'indice, il costo totale e' lineare e le scritture
+concorrenti non spostano nulla. Le colonne chiave devono essere NOT NULL e, nel
+loro insieme, univoche (l'ultima e' di norma `id`).
+
 Non usarlo per leggere tabelle intere senza filtri: paginare 50.000 righe resta
 lento anche se corretto. Se il risultato serve solo aggregato, la strada giusta
 e' una RPC che aggrega lato database (vedi `dashboard_stats_aggregata`).
@@ -39,8 +67,13 @@ e' una RPC che aggrega lato database (vedi `dashboard_stats_aggregata`).
 
 from __future__ import annotations
 
+import copy
 import logging
-from typing import Any, Dict, List
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Sequence, Tuple
+
+import httpx
 
 logger = logging.getLogger("supabase_paging")
 
@@ -51,23 +84,199 @@ PAGE_SIZE = 1000
 # una richiesta infinita che tiene occupato un thread del worker.
 MAX_ROWS = 50000
 
+# Pagine chieste in parallelo da una singola fetch_all. Basso di proposito: ogni
+# richiesta del worker puo' aprire il suo pool, e PostgREST/pgbouncer sono
+# condivisi con tutti gli altri processi. 1 = comportamento sequenziale storico.
+CONCORRENZA = max(1, int(os.environ.get("SUPABASE_PAGING_CONCURRENCY", "4")))
 
-def fetch_all(builder, page_size: int = PAGE_SIZE, max_rows: int = MAX_ROWS) -> List[Dict[str, Any]]:
+
+def fetch_all(
+    builder,
+    page_size: int = PAGE_SIZE,
+    max_rows: int = MAX_ROWS,
+    concorrenza: int | None = None,
+) -> List[Dict[str, Any]]:
     """Esegue `builder` a pagine e ritorna TUTTE le righe, non solo le prime 1000."""
+    conc = CONCORRENZA if concorrenza is None else max(1, int(concorrenza))
+    if conc > 1 and _clonabile(builder):
+        return _fetch_all_concorrente(builder, page_size, max_rows, conc)
+    return _fetch_sequenziale(lambda o: builder.range(o, o + page_size - 1), page_size, max_rows, 0, [])
+
+
+def _avvisa_troncamento(max_rows: int) -> None:
+    # Tronchiamo, ma NON in silenzio: un troncamento muto e' esattamente
+    # il difetto che questo modulo esiste per impedire.
+    logger.warning("fetch_all: raggiunto il cap di %d righe, risultato TRONCATO", max_rows)
+
+
+def _fetch_sequenziale(pagina, page_size: int, max_rows: int, offset: int,
+                       rows: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    while True:
+        batch = pagina(offset).execute().data or []
+        rows.extend(batch)
+        if len(batch) < page_size:
+            break
+        offset += page_size
+        if offset >= max_rows:
+            _avvisa_troncamento(max_rows)
+            break
+    return rows
+
+
+def _clonabile(builder) -> bool:
+    """True per il builder reale di postgrest-py: richiesta con params/headers httpx."""
+    req = getattr(builder, "request", None)
+    return (isinstance(getattr(req, "params", None), httpx.QueryParams)
+            and isinstance(getattr(req, "headers", None), httpx.Headers))
+
+
+def _clona_pagina(builder, params_base: httpx.QueryParams, offset: int, page_size: int,
+                  conta: bool = False):
+    req = copy.copy(builder.request)
+    req.params = params_base
+    req.headers = httpx.Headers(builder.request.headers)
+    if conta:
+        prefer = req.headers.get("Prefer", "")
+        if "count=" not in prefer:
+            req.headers["Prefer"] = ",".join(p for p in (prefer, "count=exact") if p)
+    pagina = copy.copy(builder)
+    pagina.request = req
+    return pagina.range(offset, offset + page_size - 1)
+
+
+def _fetch_all_concorrente(builder, page_size: int, max_rows: int, conc: int) -> List[Dict[str, Any]]:
+    base = builder.request.params  # QueryParams e' immutabile: fotografia senza range()
+    prima = _clona_pagina(builder, base, 0, page_size, conta=True).execute()
+    rows: List[Dict[str, Any]] = list(prima.data or [])
+    pagina = lambda o: _clona_pagina(builder, base, o, page_size)  # noqa: E731
+    if len(rows) < page_size:
+        return rows
+    if page_size >= max_rows:
+        _avvisa_troncamento(max_rows)
+        return rows
+    totale = getattr(prima, "count", None)
+    if not isinstance(totale, int):
+        # Conteggio non disponibile: si prosegue col ciclo sequenziale.
+        return _fetch_sequenziale(pagina, page_size, max_rows, page_size, rows)
+
+    offsets = list(range(page_size, min(totale, max_rows), page_size))
+    if offsets:
+        with ThreadPoolExecutor(max_workers=min(conc, len(offsets)),
+                                thread_name_prefix="fetch-all") as pool:
+            # map() restituisce nell'ordine degli offset: l'ordine delle righe e'
+            # quello dell'order() del chiamante, come nel ciclo sequenziale.
+            pagine = list(pool.map(lambda o: pagina(o).execute().data or [], offsets))
+        for batch in pagine:
+            rows.extend(batch)
+        ultima, prossimo = pagine[-1], offsets[-1] + page_size
+    else:
+        ultima, prossimo = rows, page_size
+
+    if len(ultima) < page_size:
+        return rows
+    if prossimo >= max_rows:
+        _avvisa_troncamento(max_rows)
+        return rows
+    # Ultima pagina piena: righe arrivate dopo il conteggio. Si continua in sequenza.
+    return _fetch_sequenziale(pagina, page_size, max_rows, prossimo, rows)
+
+
+async def fetch_all_async(builder, page_size: int = PAGE_SIZE, max_rows: int = MAX_ROWS) -> List[Dict[str, Any]]:
+    """Come `fetch_all`, per il builder di services/supabase_async (`await execute()`)."""
     rows: List[Dict[str, Any]] = []
     offset = 0
     while True:
-        resp = builder.range(offset, offset + page_size - 1).execute()
+        resp = await builder.range(offset, offset + page_size - 1).execute()
         batch = resp.data or []
         rows.extend(batch)
         if len(batch) < page_size:
             break
         offset += page_size
         if offset >= max_rows:
-            # Tronchiamo, ma NON in silenzio: un troncamento muto e' esattamente
-            # il difetto che questo modulo esiste per impedire.
             logger.warning(
-                "fetch_all: raggiunto il cap di %d righe, risultato TRONCATO", max_rows
+                "fetch_all_async: raggiunto il cap di %d righe, risultato TRONCATO", max_rows
             )
             break
     return rows
+
+
+# ── Keyset ────────────────────────────────────────────────────────────────────
+
+Chiavi = Sequence[Tuple[str, bool]]  # [(colonna, desc), ...]; l'ultima univoca
+
+
+def _letterale(v: Any) -> str:
+    # Dentro or=(...) virgole, punti, due punti e parentesi sono sintassi: le
+    # stringhe (date, timestamp, testo) vanno fra doppi apici.
+    if isinstance(v, bool) or not isinstance(v, (int, float)):
+        return '"' + str(v).replace("\\", "\\\\").replace('"', '\\"') + '"'
+    return str(v)
+
+
+def _dopo(q, chiavi: Chiavi, ultima: Dict[str, Any]):
+    """Filtro "righe dopo `ultima`" nell'ordine di `chiavi`."""
+    if len(chiavi) == 1:
+        col, desc = chiavi[0]
+        return q.lt(col, ultima[col]) if desc else q.gt(col, ultima[col])
+    # (a, b) > (va, vb)  ⇔  a > va  OR  (a = va AND b > vb), esteso a N colonne.
+    rami = []
+    for i, (col, desc) in enumerate(chiavi):
+        uguali = [f"{c}.eq.{_letterale(ultima[c])}" for c, _ in chiavi[:i]]
+        stretto = f"{col}.{'lt' if desc else 'gt'}.{_letterale(ultima[col])}"
+        rami.append(f"and({','.join(uguali + [stretto])})" if uguali else stretto)
+    return q.or_(",".join(rami))
+
+
+def _pagina_keyset(query: Callable[[], Any], chiavi: Chiavi, ultima, page_size: int):
+    q = query()
+    if ultima is not None:
+        q = _dopo(q, chiavi, ultima)
+    for col, desc in chiavi:
+        q = q.order(col, desc=desc)
+    return q.limit(page_size)
+
+
+def fetch_all_keyset(
+    query: Callable[[], Any],
+    chiavi: Chiavi = (("id", False),),
+    page_size: int = PAGE_SIZE,
+    max_rows: int = MAX_ROWS,
+) -> List[Dict[str, Any]]:
+    """Scansione completa paginata per chiave invece che per offset.
+
+    `query` costruisce a ogni chiamata la query GIA' filtrata, senza order() ne'
+    range() (il builder di supabase-py e' mutabile: serve una query nuova per
+    pagina). La select deve includere le colonne di `chiavi`, che definiscono
+    anche l'ordine delle righe restituite.
+    """
+    rows: List[Dict[str, Any]] = []
+    ultima = None
+    while True:
+        batch = _pagina_keyset(query, chiavi, ultima, page_size).execute().data or []
+        rows.extend(batch)
+        if len(batch) < page_size:
+            return rows
+        if len(rows) >= max_rows:
+            logger.warning("fetch_all_keyset: raggiunto il cap di %d righe, risultato TRONCATO", max_rows)
+            return rows
+        ultima = batch[-1]
+
+
+async def fetch_all_keyset_async(
+    query: Callable[[], Any],
+    chiavi: Chiavi = (("id", False),),
+    page_size: int = PAGE_SIZE,
+    max_rows: int = MAX_ROWS,
+) -> List[Dict[str, Any]]:
+    """Come `fetch_all_keyset`, per il builder di services/supabase_async."""
+    rows: List[Dict[str, Any]] = []
+    ultima = None
+    while True:
+        batch = (await _pagina_keyset(query, chiavi, ultima, page_size).execute()).data or []
+        rows.extend(batch)
+        if len(batch) < page_size:
+            return rows
+        if len(rows) >= max_rows:
+            logger.warning("fetch_all_keyset_async: raggiunto il cap di %d righe, risultato TRONCATO", max_rows)
+            return rows
+        ultima = batch[-1]
@@ -9,7 +9,7 @@ MAI per dati dove serve coerenza forte immediata.
 
 Uso tipico:
     from utils.ttl_cache import TTLCache
-    _overview_cache = TTLCache(ttl=45.0)
+    _overview_cache = TTLCache(ttl=45.0, nome="admin", max_entries=64)
 
     def admin_overview():
         return _overview_cache.get_or_set("overview", _compute_overview)
@@ -18,42 +18,187 @@ Uso tipico:
 gli altri thread che leggono chiavi diverse. Piccola race possibile (due thread
 calcolano la stessa chiave insieme al primo miss): accettabile, il risultato e'
 identico e idempotente.
+
+Limiti e visibilita'. Le cache del worker erano dict ad-hoc senza limite, con le
+voci scadute mai rimosse: coi clienti grandi l'RSS saliva finche' Railway non
+riavviava il container. Qui ogni cache puo' avere:
+
+- `max_entries` e/o `max_bytes`: oltre, esce la voce usata meno di recente
+  (LRU: lettura e scrittura la spostano in coda). La dimensione di ogni voce e'
+  stimata una volta sola, alla scrittura (`stima_bytes`, a campione).
+- pulizia delle scadute: a ogni lettura della chiave, ogni `_SWEEP_OGNI_SET`
+  scritture e dal thread di `avvia_sweep()` (lifespan del worker).
+- contatori hit/miss/evictions/scadute e byte stimati: le cache con `nome`
+  finiscono nel registro letto da `statistiche()` (salute-worker).
 """
 
 from __future__ import annotations
 
+import logging
+import sys
 import threading
 import time
-from typing import Any, Callable, Dict, Optional, Tuple
+import weakref
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable, List, Optional, Tuple
+
+logger = logging.getLogger("ttl_cache")
+
+# Ogni quante scritture una cache ripulisce le proprie voci scadute (anche
+# senza il thread di sweep: processi senza lifespan, queue worker, test).
+_SWEEP_OGNI_SET = 256
+
+# Stima a campione: dei contenitori grandi si misurano i primi N elementi e
+# si estrapola. Profondita' limitata: e' un ordine di grandezza, non un profiler.
+_CAMPIONE = 32
+_PROFONDITA_MAX = 6
+
+
+def stima_bytes(valore: Any, _profondita: int = 0) -> int:
+    """Occupazione approssimata di `valore` (byte), in tempo limitato."""
+    nbytes = getattr(valore, "nbytes", None)
+    if callable(nbytes):          # RigheColonnari e simili
+        try:
+            return int(nbytes())
+        except Exception:
+            return sys.getsizeof(valore)
+    if isinstance(nbytes, int):   # array numpy
+        return nbytes + sys.getsizeof(valore)
+    base = sys.getsizeof(valore)
+    if _profondita >= _PROFONDITA_MAX or isinstance(valore, (str, bytes, int, float, bool, type(None))):
+        return base
+    if isinstance(valore, dict):
+        voci = list(valore.items())
+        campione = voci[:_CAMPIONE]
+        if not campione:
+            return base
+        parziale = sum(stima_bytes(k, _profondita + 1) + stima_bytes(v, _profondita + 1) for k, v in campione)
+        return base + parziale * len(voci) // len(campione)
+    if isinstance(valore, (list, tuple, set, frozenset)):
+        elementi = valore if isinstance(valore, (list, tuple)) else list(valore)
+        campione = elementi[:_CAMPIONE]
+        if not campione:
+            return base
+        parziale = sum(stima_bytes(v, _profondita + 1) for v in campione)
+        return base + parziale * len(elementi) // len(campione)
+    attributi = getattr(valore, "__dict__", None)
+    if isinstance(attributi, dict):   # modelli pydantic, dataclass
+        return base + stima_bytes(attributi, _profondita + 1)
+    return base
+
+
+# Registro delle cache con nome: riferimenti deboli, una cache non piu'
+# referenziata (es. creata in un test) sparisce da sola.
+_registro: "weakref.WeakValueDictionary[str, TTLCache]" = weakref.WeakValueDictionary()
+_registro_lock = threading.Lock()
 
 
 class TTLCache:
-    def __init__(self, ttl: float) -> None:
+    def __init__(
+        self,
+        ttl: float,
+        nome: Optional[str] = None,
+        max_entries: Optional[int] = None,
+        max_bytes: Optional[int] = None,
+    ) -> None:
         self._ttl = float(ttl)
-        self._store: Dict[str, Tuple[float, Any]] = {}
+        self.nome = nome
+        self._max_entries = int(max_entries) if max_entries else None
+        self._max_bytes = int(max_bytes) if max_bytes else None
+        # chiave -> (scade_at monotonic, valore, byte stimati); ordine = LRU.
+        self._store: "OrderedDict[Hashable, Tuple[float, Any, int]]" = OrderedDict()
+        self._bytes = 0
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+        self._scadute = 0
+        self._set_da_sweep = 0
         self._lock = threading.Lock()
         # Single-flight: un lock PER-CHIAVE creato al bisogno. Quando N thread
         # chiedono la stessa chiave fredda insieme (tipico: la Home spara 6-7
         # richieste in parallelo prima che la cache si scaldi), solo il primo
         # calcola; gli altri aspettano il SUO risultato invece di rifare la stessa
         # query. Chiavi diverse non si bloccano a vicenda.
-        self._flight_locks: Dict[str, threading.Lock] = {}
+        self._flight_locks: Dict[Hashable, threading.Lock] = {}
         self._flight_guard = threading.Lock()
+        if nome:
+            with _registro_lock:
+                _registro[nome] = self
+
+    # ── lettura ──────────────────────────────────────────────────────────────
+
+    def _lookup(self, key: Hashable, now: float) -> Tuple[bool, Any]:
+        """(trovata, valore) sotto lock; rimuove la voce se scaduta."""
+        entry = self._store.get(key)
+        if entry is None:
+            return False, None
+        if entry[0] <= now:
+            self._rimuovi(key)
+            self._scadute += 1
+            return False, None
+        self._store.move_to_end(key)
+        return True, entry[1]
 
-    def get(self, key: str) -> Optional[Any]:
-        """Valore cached se presente e non scaduto, altrimenti None."""
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        """Valore cached se presente e non scaduto, altrimenti `default` (None).
+
+        Per le cache che memorizzano anche None come valore valido, passare un
+        sentinel come `default` per distinguere il miss.
+        """
+        with self._lock:
+            trovata, valore = self._lookup(key, time.monotonic())
+            if trovata:
+                self._hits += 1
+                return valore
+            self._misses += 1
+        return default
+
+    def __contains__(self, key: Hashable) -> bool:
+        entry = self._store.get(key)
+        return entry is not None and entry[0] > time.monotonic()
+
+    def __len__(self) -> int:
+        return len(self._store)
+
+    def keys(self) -> List[Hashable]:
+        """Chiavi non scadute (copia: si puo' invalidare mentre si itera)."""
         now = time.monotonic()
         with self._lock:
-            entry = self._store.get(key)
-            if entry is not None and entry[0] > now:
-                return entry[1]
-        return None
+            return [k for k, e in self._store.items() if e[0] > now]
 
-    def set(self, key: str, value: Any) -> None:
+    # ── scrittura ────────────────────────────────────────────────────────────
+
+    def set(self, key: Hashable, value: Any, ttl: Optional[float] = None) -> None:
+        # Stima fuori dal lock: su un RigheColonnari grande non e' gratis.
+        size = stima_bytes(value)
+        now = time.monotonic()
         with self._lock:
-            self._store[key] = (time.monotonic() + self._ttl, value)
+            if key in self._store:
+                self._rimuovi(key)
+            self._store[key] = (now + (self._ttl if ttl is None else float(ttl)), value, size)
+            self._bytes += size
+            self._set_da_sweep += 1
+            if self._set_da_sweep >= _SWEEP_OGNI_SET:
+                self._sweep_locked(now)
+            self._rispetta_limiti()
+
+    def _rimuovi(self, key: Hashable) -> None:
+        entry = self._store.pop(key, None)
+        if entry is not None:
+            self._bytes -= entry[2]
 
-    def _flight_lock_for(self, key: str) -> threading.Lock:
+    def _rispetta_limiti(self) -> None:
+        # Una voce da sola oltre max_bytes non resta in cache: il limite e' il
+        # tetto di RSS che la cache puo' occupare, non un suggerimento.
+        while self._store and (
+            (self._max_entries is not None and len(self._store) > self._max_entries)
+            or (self._max_bytes is not None and self._bytes > self._max_bytes)
+        ):
+            key = next(iter(self._store))
+            self._rimuovi(key)
+            self._evictions += 1
+
+    def _flight_lock_for(self, key: Hashable) -> threading.Lock:
         with self._flight_guard:
             lk = self._flight_locks.get(key)
             if lk is None:
@@ -61,27 +206,120 @@ class TTLCache:
                 self._flight_locks[key] = lk
             return lk
 
-    def get_or_set(self, key: str, producer: Callable[[], Any]) -> Any:
+    def get_or_set(self, key: Hashable, producer: Callable[[], Any]) -> Any:
         """Ritorna il valore cached; se assente/scaduto chiama `producer` UNA sola
         volta anche sotto richieste concorrenti (single-flight), lo memorizza e lo
         ritorna. Il producer gira fuori dal lock globale della cache."""
-        cached = self.get(key)
-        if cached is not None:
-            return cached
+        with self._lock:
+            trovata, cached = self._lookup(key, time.monotonic())
+            if trovata and cached is not None:
+                self._hits += 1
+                return cached
         # Solo un thread per chiave entra qui; gli altri aspettano e poi trovano
         # il valore gia' in cache (ricontrollo dopo aver preso il lock).
-        with self._flight_lock_for(key):
+        lk = self._flight_lock_for(key)
+        with lk:
             cached = self.get(key)
             if cached is not None:
                 return cached
-            value = producer()
-            self.set(key, value)
+            try:
+                value = producer()
+                self.set(key, value)
+            finally:
+                # Il lock per-chiave non serve piu' (chi aspettava lo tiene gia'):
+                # senza pulizia il dizionario cresceva con ogni chiave mai vista.
+                with self._flight_guard:
+                    if self._flight_locks.get(key) is lk:
+                        del self._flight_locks[key]
             return value
 
-    def invalidate(self, key: Optional[str] = None) -> None:
+    # ── invalidazione e pulizia ──────────────────────────────────────────────
+
+    def invalidate(self, key: Optional[Hashable] = None) -> None:
         """Invalida una chiave, o tutta la cache se key is None."""
         with self._lock:
             if key is None:
                 self._store.clear()
+                self._bytes = 0
             else:
-                self._store.pop(key, None)
+                self._rimuovi(key)
+
+    def invalidate_where(self, predicato: Callable[[Hashable], bool]) -> int:
+        """Invalida le chiavi per cui `predicato(chiave)` e' vero (es. un prefisso
+        per ristorante); ritorna quante ne ha tolte."""
+        with self._lock:
+            chiavi = [k for k in self._store if predicato(k)]
+            for k in chiavi:
+                self._rimuovi(k)
+            return len(chiavi)
+
+    def _sweep_locked(self, now: float) -> int:
+        self._set_da_sweep = 0
+        scadute = [k for k, e in self._store.items() if e[0] <= now]
+        for k in scadute:
+            self._rimuovi(k)
+        self._scadute += len(scadute)
+        return len(scadute)
+
+    def sweep(self) -> int:
+        """Rimuove le voci scadute; ritorna quante."""
+        with self._lock:
+            return self._sweep_locked(time.monotonic())
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            richieste = self._hits + self._misses
+            return {
+                "nome": self.nome,
+                "voci": len(self._store),
+                "bytes_stimati": self._bytes,
+                "max_voci": self._max_entries,
+                "max_bytes": self._max_bytes,
+                "ttl_s": self._ttl,
+                "hit": self._hits,
+                "miss": self._misses,
+                "hit_ratio": round(self._hits / richieste, 3) if richieste else None,
+                "evictions": self._evictions,
+                "scadute": self._scadute,
+            }
+
+
+def cache_registrate() -> List[TTLCache]:
+    with _registro_lock:
+        return list(_registro.values())
+
+
+def statistiche() -> List[Dict[str, Any]]:
+    """Statistiche delle cache con nome del processo, le piu' pesanti prima."""
+    out = [c.stats() for c in cache_registrate()]
+    out.sort(key=lambda s: s["bytes_stimati"], reverse=True)
+    return out
+
+
+def sweep_tutte() -> int:
+    return sum(c.sweep() for c in cache_registrate())
+
+
+_sweep_thread: Optional[threading.Thread] = None
+_sweep_avvio_lock = threading.Lock()
+
+
+def avvia_sweep(intervallo_s: float = 60.0) -> None:
+    """Avvia (una volta per processo) il thread daemon che ripulisce le voci
+    scadute di tutte le cache registrate: una chiave letta una volta sola non
+    verrebbe mai piu' toccata e resterebbe in memoria fino all'eviction LRU."""
+    global _sweep_thread
+    with _sweep_avvio_lock:
+        if _sweep_thread is not None and _sweep_thread.is_alive():
+            return
+
+        def _ciclo() -> None:
+            while True:
+                time.sleep(intervallo_s)
+                try:
+                    sweep_tutte()
+                except Exception as exc:  # pragma: no cover - il thread non deve morire
+                    logger.warning("sweep cache in-process fallito: %s", exc)
+
+        _sweep_thread = threading.Thread(target=_ciclo, name="ttl-cache-sweep", daemon=True)
+        _sweep_thread.start()
@@ -220,12 +220,10 @@ def run_email_cycle(supabase, worker_url: str = "", worker_secret: str = "") ->
         # trigger sync_margini_mensili_from_ricavi riscrive margini_mensili, da cui
         # leggono i KPI di Home. Su OGNI sede scritta, non solo quella del mittente:
         # un file di catena alimenta più locali.
-        # Nota sui limiti: qui gira il queue-worker, un processo Railway DIVERSO da
-        # quello che serve la Home. _HOME_KPI_CACHE è in-memoria per-processo,
-        # quindi questa chiamata pulisce la propria copia e i KPI dell'altro
-        # processo restano stantii fino al TTL (stessa limitazione nota della cache
-        # per-processo, AUDIT §3). L'invalidazione del briefing passa dal DB e vale
-        # per tutti.
+        # Qui gira il queue-worker, un processo Railway DIVERSO da quello che serve
+        # la Home: _HOME_KPI_CACHE è in-memoria per-processo, la chiamata pulisce
+        # la propria copia e pubblica l'evento su cache_bus, da cui i processi web
+        # puliscono la loro. L'invalidazione del briefing passa dal DB.
         for rid in per_ristorante:
             try:
                 _invalidate_home_kpi_cache(str(rid))
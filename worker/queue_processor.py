@@ -8,7 +8,8 @@ Flusso per ogni ciclo:
   2. purge_raw_body_sample()          → GDPR cleanup (body diagnostico > 90gg)
   3. release_stale_locks()            → libera worker bloccati > 10 min
   4. claim_batch_for_processing()     → acquisisce atomicamente N record
-  5. Per ogni record:
+  5. Per ogni record (in parallelo fino a WORKER_CONCURRENCY, sequenziale per
+     la stessa sede: vedi _raggruppa_per_tenant):
        a. Legge xml_content da fatture_queue
        b. Chiama estrai_dati_da_xml() — parser esistente, zero duplicazione
        c. Chiama salva_fattura_processata() — insert in public.fatture
@@ -33,6 +34,7 @@ import sys
 import threading
 import time
 import uuid
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass, field
 from typing import Any, Optional
 
@@ -54,6 +56,7 @@ if _PROJECT_ROOT not in sys.path:
     sys.path.insert(0, _PROJECT_ROOT)
 
 from services.db_service import filter_active
+from services.dedup_contenuto import documento_gia_elaborato, hash_contenuto_xml, registra_documento_elaborato
 from services.invoice_service import estrai_dati_da_xml, estrai_xml_da_p7m, salva_fattura_processata, _to_int_safe
 from services.worker_client import classifica_via_worker_con_confidenza
 
@@ -409,6 +412,11 @@ RAW_BODY_SAMPLE_RETENTION_D = int(os.environ.get("WORKER_RAW_BODY_SAMPLE_RETENTI
 STALE_LOCK_MIN    = int(os.environ.get("WORKER_STALE_LOCK_MINUTES", "10"))
 WORKER_ID_PREFIX  = os.environ.get("WORKER_ID_PREFIX", "gh-action")
 JOB_TIMEOUT       = int(os.environ.get("WORKER_JOB_TIMEOUT_SECONDS", "300"))
+# Item elaborati in parallelo per ciclo. Il lavoro e' quasi tutto I/O (download
+# XML, upsert Supabase, chiamate AI): con l'elaborazione strettamente sequenziale
+# i picchi SDI del mattino accumulavano decine di minuti di coda. 1 = comportamento
+# storico (un item alla volta).
+CONCURRENCY       = max(1, int(os.environ.get("WORKER_CONCURRENCY", "4")))
 
 
 # ─── Tipi di risultato ────────────────────────────────────────────────────────
@@ -431,11 +439,32 @@ class CycleStats:
     dead: int = 0
     skipped: int = 0
     errors: list[str] = field(default_factory=list)
+    # Throughput del ciclo: quante corsie parallele, righe salvate, durata della
+    # fase di elaborazione (claim escluso) e durata di ogni item.
+    concurrency: int = 1
+    rows: int = 0
+    elapsed_s: float = 0.0
+    item_seconds: list[float] = field(default_factory=list)
 
     @property
     def total_processed(self) -> int:
         return self.done + self.retry_scheduled + self.dead + self.skipped
 
+    @property
+    def items_per_minute(self) -> float:
+        return self.total_processed * 60.0 / self.elapsed_s if self.elapsed_s > 0 else 0.0
+
+    @property
+    def rows_per_second(self) -> float:
+        return self.rows / self.elapsed_s if self.elapsed_s > 0 else 0.0
+
+    @property
+    def pool_utilization(self) -> float:
+        """Quota del tempo-corsia speso a elaborare (1.0 = pool sempre pieno).
+        Bassa con molti item = poche sedi distinte nel batch (corsie serializzate)."""
+        capacita = self.elapsed_s * self.concurrency
+        return min(1.0, sum(self.item_seconds) / capacita) if capacita > 0 else 0.0
+
     def log_summary(self) -> None:
         logger.info(
             "[worker=%s] Ciclo completato - claimed=%d done=%d retry=%d dead=%d skip=%d",
@@ -446,10 +475,33 @@ class CycleStats:
             self.dead,
             self.skipped,
         )
+        if self.total_processed:
+            logger.info(
+                "[worker=%s] Throughput - %.1fs, corsie=%d, %.1f item/min, %.1f righe/s, "
+                "item max=%.1fs, utilizzo pool=%.0f%%",
+                self.worker_id,
+                self.elapsed_s,
+                self.concurrency,
+                self.items_per_minute,
+                self.rows_per_second,
+                max(self.item_seconds, default=0.0),
+                self.pool_utilization * 100,
+            )
         for err in self.errors:
             logger.warning("[worker=%s] %s", self.worker_id, err)
 
 
+@dataclass
+class _EsitoItem:
+    """Esito finale di un item dopo l'aggiornamento di fatture_queue, prodotto
+    dalle corsie parallele e contato in CycleStats dal thread del ciclo."""
+    queue_id: int
+    bucket: str | None   # "done" | "retry" | "dead" | "skip" | None (non contato)
+    secondi: float
+    righe: int = 0
+    errore: str | None = None
+
+
 # ─── Funzioni di manutenzione (chiamate RPC Supabase) ─────────────────────────
 
 def _purge_xml(supabase, retention_hours: int) -> int:
@@ -620,6 +672,20 @@ def _process_item(supabase, item: dict[str, Any], worker_id: Optional[str] = Non
     xml_bytes = xml_content.encode("utf-8") if isinstance(xml_content, str) else xml_content
     xml_io    = _make_file_like(xml_bytes, nome_file)
 
+    # ── Dedup per contenuto ───────────────────────────────────────────────────
+    # Stesso XML gia' salvato (e ancora attivo) su questa sede: durante
+    # l'onboarding dello storico e con i retry SDI capita spesso. Niente parse,
+    # salvataggio ne' AI: l'item si chiude subito come fatto.
+    hash_contenuto = hash_contenuto_xml(xml_bytes)
+    if user_id and ristorante_id:
+        gia_elaborato = documento_gia_elaborato(supabase, ristorante_id, hash_contenuto)
+        if gia_elaborato:
+            logger.info(
+                "[item=%d] contenuto gia' elaborato come %s — done senza riparsare",
+                queue_id, gia_elaborato,
+            )
+            return ItemResult(queue_id=queue_id, event_id=event_id, status="done", righe=0)
+
     # ── Parsing XML ───────────────────────────────────────────────────────────
     try:
         dati_prodotti = estrai_dati_da_xml(xml_io, user_id=user_id)
@@ -729,6 +795,12 @@ def _process_item(supabase, item: dict[str, Any], worker_id: Optional[str] = Non
     if item.get("source", "invoicetronic") == "invoicetronic":
         _advance_nuovi_da_daily(supabase, ristorante_id)
 
+    # Registrato solo a item completo (salvato E classificato): un item in retry
+    # deve poter rifare tutto il giro.
+    registra_documento_elaborato(
+        supabase, ristorante_id, user_id, hash_contenuto, nome_file, righe=result.get("righe", 0),
+    )
+
     return ItemResult(
         queue_id=queue_id,
         event_id=event_id,
@@ -1033,12 +1105,154 @@ def _fetch_xml_via_api(resource_id: Any) -> str | None:
     return None
 
 
+# ─── Elaborazione parallela ───────────────────────────────────────────────────
+
+def _raggruppa_per_tenant(batch: list[dict[str, Any]]) -> list[list[dict[str, Any]]]:
+    """Divide il batch in corsie: una per sede, nell'ordine di claim.
+
+    Gli item della STESSA sede restano sequenziali, nell'ordine in cui sono
+    stati claimati: salva_fattura_processata, la marcatura della sede tecnica e
+    _advance_nuovi_da_daily lavorano per ristorante_id, e due fatture dello
+    stesso fornitore/sede in parallelo si contenderebbero le stesse righe (è lo
+    stesso motivo dell'upload lock per sede del flusso manuale). Sedi diverse
+    non condividono nulla e vanno in parallelo. Item senza sede (tenant non
+    risolto, finiranno in retry) ricadono sull'utente o stanno da soli.
+    """
+    corsie: dict[Any, list[dict[str, Any]]] = {}
+    for item in batch:
+        chiave = item.get("ristorante_id") or item.get("user_id") or ("item", item.get("id"))
+        corsie.setdefault(chiave, []).append(item)
+    return list(corsie.values())
+
+
+def _esegui_con_watchdog(supabase, item: dict[str, Any], worker_id: str) -> ItemResult | None:
+    """Esegue _process_item in un thread daemon con timeout JOB_TIMEOUT.
+
+    Ritorna None al timeout. Il thread non è cancellabile e continua a girare:
+    è _claim_ancora_valido, dentro _process_item, a fermarlo prima dei
+    side-effect se nel frattempo l'item viene riclamato.
+    """
+    queue_id = item["id"]
+    job_done: threading.Event = threading.Event()
+    job_result: list[ItemResult | None] = [None]
+    job_exc: list[BaseException | None] = [None]
+
+    def _run_job() -> None:
+        try:
+            job_result[0] = _process_item(supabase, item, worker_id=worker_id)
+        except Exception as e:
+            job_exc[0] = e
+        finally:
+            job_done.set()
+
+    _t = threading.Thread(target=_run_job, daemon=True)
+    _t.start()
+    if not job_done.wait(timeout=JOB_TIMEOUT):
+        return None
+
+    if job_exc[0] is not None:
+        # Safety net: non deve mai crashare il ciclo
+        logger.error("[item=%d] Eccezione imprevista nel processor", queue_id, exc_info=job_exc[0])
+        return ItemResult(
+            queue_id=queue_id,
+            event_id=str(item.get("event_id", "?")),
+            status="retry",
+            error=f"Unhandled exception: {job_exc[0]}",
+        )
+    return job_result[0]
+
+
+def _finalizza_item(supabase, item: dict[str, Any], result: ItemResult | None, elapsed: float) -> _EsitoItem:
+    """Aggiorna fatture_queue con l'esito dell'item (done / retry / dead / skip)."""
+    queue_id = item["id"]
+
+    if result is None:
+        logger.error(
+            "[item=%d event=%s] Job timeout (%ds) — scheduled retry",
+            queue_id, item.get("event_id", "?"), JOB_TIMEOUT,
+        )
+        try:
+            _schedule_retry(supabase, queue_id, f"job timeout after {JOB_TIMEOUT}s")
+            return _EsitoItem(queue_id, "retry", elapsed)
+        except Exception as retry_exc:
+            logger.error("[item=%d] schedule_retry dopo timeout fallita: %s", queue_id, retry_exc)
+            return _EsitoItem(queue_id, None, elapsed, errore=f"item={queue_id} timeout+retry_failed={retry_exc}")
+
+    if result.status == "done":
+        try:
+            _mark_done(supabase, queue_id, purge_xml=True)
+            logger.info(
+                "[item=%d event=%s] Done - %d righe in %.1fs",
+                queue_id, result.event_id, result.righe, elapsed,
+            )
+            return _EsitoItem(queue_id, "done", elapsed, righe=result.righe)
+        except Exception as exc:
+            logger.error("[item=%d] mark_done fallita: %s", queue_id, exc)
+            return _EsitoItem(queue_id, None, elapsed, errore=f"item={queue_id} mark_done={exc}")
+
+    if result.status == "retry":
+        try:
+            _schedule_retry(supabase, queue_id, result.error or "errore sconosciuto")
+        except Exception as exc:
+            logger.error("[item=%d] schedule_retry fallita: %s", queue_id, exc)
+            return _EsitoItem(queue_id, "retry", elapsed, errore=f"item={queue_id} schedule_retry={exc}")
+        # Controlla se è diventato dead (attempt >= max_attempts).
+        # Usa maybe_single() per non crashare se la riga è stata rimossa
+        # (race con cleanup esterno o purge).
+        try:
+            updated = (
+                supabase.table("fatture_queue")
+                .select("status")
+                .eq("id", queue_id)
+                .maybe_single()
+                .execute()
+            )
+            final_status = ((updated.data if updated else None) or {}).get("status", "failed")
+        except Exception as verify_exc:
+            logger.warning(
+                "[item=%d] verifica status post-retry fallita: %s",
+                queue_id, verify_exc,
+            )
+            final_status = "unknown"
+        if final_status == "dead":
+            logger.warning(
+                "[item=%d event=%s] DEAD - max tentativi raggiunto: %s",
+                queue_id, result.event_id, result.error,
+            )
+            return _EsitoItem(queue_id, "dead", elapsed)
+        logger.warning(
+            "[item=%d event=%s] Retry schedulato - %s",
+            queue_id, result.event_id, result.error,
+        )
+        return _EsitoItem(queue_id, "retry", elapsed)
+
+    # "skip" o altro
+    return _EsitoItem(queue_id, "skip", elapsed)
+
+
+def _elabora_corsia(supabase, items: list[dict[str, Any]], worker_id: str) -> list[_EsitoItem]:
+    """Elabora in sequenza gli item di una corsia (stessa sede), ognuno con il
+    suo watchdog. Gira in un thread del pool: non deve mai sollevare."""
+    esiti: list[_EsitoItem] = []
+    for item in items:
+        t0 = time.monotonic()
+        try:
+            result = _esegui_con_watchdog(supabase, item, worker_id)
+            esiti.append(_finalizza_item(supabase, item, result, time.monotonic() - t0))
+        except Exception as exc:  # pragma: no cover - difensivo
+            logger.exception("[item=%s] errore imprevisto nella corsia", item.get("id"))
+            esiti.append(_EsitoItem(item.get("id"), None, time.monotonic() - t0,
+                                    errore=f"item={item.get('id')} corsia={exc}"))
+    return esiti
+
+
 # ─── Entry point principale ───────────────────────────────────────────────────
 
 def run_cycle() -> CycleStats:
     """
     Esegue un ciclo completo del worker:
-      manutenzione → claim → elabora ogni item → stats
+      manutenzione → claim → elabora gli item (corsie per sede in parallelo,
+      fino a CONCURRENCY) → stats
 
     Returns:
         CycleStats con i risultati del ciclo
@@ -1071,116 +1285,32 @@ def run_cycle() -> CycleStats:
 
     logger.info("[worker=%s] Claimati %d record", worker_id, len(batch))
 
-    # ── 3. Elabora ogni item ──────────────────────────────────────────────────
-    for item in batch:
-        queue_id = item["id"]
-        t0 = time.monotonic()
-
-        # ── Watchdog timeout per singolo job ─────────────────────────────────
-        job_done: threading.Event = threading.Event()
-        job_result: list[ItemResult | None] = [None]
-        job_exc: list[BaseException | None] = [None]
-
-        def _run_job(
-            _supabase=supabase,
-            _item=item,
-            _done=job_done,
-            _res=job_result,
-            _exc=job_exc,
-            _worker_id=worker_id,
-        ) -> None:
-            try:
-                _res[0] = _process_item(_supabase, _item, worker_id=_worker_id)
-            except Exception as e:
-                _exc[0] = e
-            finally:
-                _done.set()
-
-        _t = threading.Thread(target=_run_job, daemon=True)
-        _t.start()
-        completed = job_done.wait(timeout=JOB_TIMEOUT)
-
-        if not completed:
-            elapsed = time.monotonic() - t0
-            logger.error(
-                "[item=%d event=%s] Job timeout (%ds) — scheduled retry",
-                queue_id, item.get("event_id", "?"), JOB_TIMEOUT,
-            )
-            try:
-                _schedule_retry(supabase, queue_id, f"job timeout after {JOB_TIMEOUT}s")
-                stats.retry_scheduled += 1
-            except Exception as retry_exc:
-                logger.error("[item=%d] schedule_retry dopo timeout fallita: %s", queue_id, retry_exc)
-                stats.errors.append(f"item={queue_id} timeout+retry_failed={retry_exc}")
-            continue
-
-        elapsed = time.monotonic() - t0
-
-        if job_exc[0] is not None:
-            exc = job_exc[0]
-            # Safety net: non deve mai crashare il ciclo
-            logger.exception("[item=%d] Eccezione imprevista nel processor", queue_id)
-            result = ItemResult(
-                queue_id=queue_id,
-                event_id=str(item.get("event_id", "?")),
-                status="retry",
-                error=f"Unhandled exception: {exc}",
-            )
-        else:
-            result = job_result[0]
-
-        # ── Aggiorna stato in DB ───────────────────────────────────────────
-        if result.status == "done":
-            try:
-                _mark_done(supabase, queue_id, purge_xml=True)
-                stats.done += 1
-                logger.info(
-                    "[item=%d event=%s] Done - %d righe in %.1fs",
-                    queue_id, result.event_id, result.righe, elapsed,
-                )
-            except Exception as exc:
-                logger.error("[item=%d] mark_done fallita: %s", queue_id, exc)
-                stats.errors.append(f"item={queue_id} mark_done={exc}")
-
-        elif result.status == "retry":
-            try:
-                _schedule_retry(supabase, queue_id, result.error or "errore sconosciuto")
-                # Controlla se è diventato dead (attempt >= max_attempts).
-                # Usa maybe_single() per non crashare se la riga è stata rimossa
-                # (race con cleanup esterno o purge).
-                try:
-                    updated = (
-                        supabase.table("fatture_queue")
-                        .select("status")
-                        .eq("id", queue_id)
-                        .maybe_single()
-                        .execute()
-                    )
-                    final_status = ((updated.data if updated else None) or {}).get("status", "failed")
-                except Exception as verify_exc:
-                    logger.warning(
-                        "[item=%d] verifica status post-retry fallita: %s",
-                        queue_id, verify_exc,
-                    )
-                    final_status = "unknown"
-                if final_status == "dead":
-                    stats.dead += 1
-                    logger.warning(
-                        "[item=%d event=%s] DEAD - max tentativi raggiunto: %s",
-                        queue_id, result.event_id, result.error,
-                    )
-                else:
-                    stats.retry_scheduled += 1
-                    logger.warning(
-                        "[item=%d event=%s] Retry schedulato - %s",
-                        queue_id, result.event_id, result.error,
-                    )
-            except Exception as exc:
-                stats.retry_scheduled += 1
-                logger.error("[item=%d] schedule_retry fallita: %s", queue_id, exc)
-                stats.errors.append(f"item={queue_id} schedule_retry={exc}")
-
-        else:  # "skip" o altro
+    # ── 3. Elabora gli item: corsie per sede in parallelo ─────────────────────
+    corsie = _raggruppa_per_tenant(batch)
+    stats.concurrency = min(CONCURRENCY, len(corsie))
+    t_ciclo = time.monotonic()
+    if stats.concurrency <= 1:
+        esiti = [e for corsia in corsie for e in _elabora_corsia(supabase, corsia, worker_id)]
+    else:
+        with ThreadPoolExecutor(
+            max_workers=stats.concurrency, thread_name_prefix=f"queue-{worker_id[-8:]}",
+        ) as pool:
+            futures = [pool.submit(_elabora_corsia, supabase, corsia, worker_id) for corsia in corsie]
+            esiti = [e for f in futures for e in f.result()]
+    stats.elapsed_s = time.monotonic() - t_ciclo
+
+    for esito in esiti:
+        stats.item_seconds.append(esito.secondi)
+        if esito.bucket == "done":
+            stats.done += 1
+            stats.rows += esito.righe
+        elif esito.bucket == "retry":
+            stats.retry_scheduled += 1
+        elif esito.bucket == "dead":
+            stats.dead += 1
+        elif esito.bucket == "skip":
             stats.skipped += 1
+        if esito.errore:
+            stats.errors.append(esito.errore)
 
     return stats
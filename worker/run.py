@@ -19,6 +19,7 @@ ENV VARS:
     SUPABASE_SERVICE_ROLE_KEY     obbligatorio (service_role, non anon key)
     INVOICETRONIC_API_KEY         opzionale (solo per fallback xml_url)
     WORKER_BATCH_SIZE             default 10
+    WORKER_CONCURRENCY            default 4   (item in parallelo per ciclo; stessa sede in sequenza)
     WORKER_XML_RETENTION_HOURS    default 24  (GDPR purge)
     WORKER_STALE_LOCK_MINUTES     default 10  (lock recovery)
     WORKER_ID_PREFIX              default "gh-action"
@@ -28,6 +29,11 @@ ENV VARS:
     WORKER_PURGE_INTERVAL_SECONDS     default 21600 (purge cestino ogni 6h)
     WORKER_RETENTION_INTERVAL_SECONDS default 86400 (retention fatture >2 anni ogni 24h)
     WORKER_QUEUE_PURGE_INTERVAL_SECONDS default 21600 (purge xml_content/raw_body_sample fatture_queue ogni 6h)
+    WORKER_WAKEUP_PORT                opzionale (porta HTTP della sveglia coda, vedi services/queue_wakeup.py;
+                                      richiede WORKER_SECRET_KEY. Assente = solo polling)
+    WORKER_WAKEUP_FALLBACK_POLL_SECONDS default 60 (polling di sicurezza quando la sveglia e' attiva)
+    ONEFLUX_CACHE_BUS_POLL_S          default 2 (services/cache_bus: invalidazioni cache verso i
+                                      processi web; 0 = disattivato)
 
 EXIT CODES:
     0  — ciclo completato (anche se coda vuota)
@@ -92,6 +98,9 @@ WORKER_MAX_BACKOFF_SECONDS = int(os.environ.get("WORKER_MAX_BACKOFF_SECONDS", "3
 WORKER_PURGE_INTERVAL_SECONDS = int(os.environ.get("WORKER_PURGE_INTERVAL_SECONDS", str(6 * 3600)))  # default 6h
 WORKER_RETENTION_INTERVAL_SECONDS = int(os.environ.get("WORKER_RETENTION_INTERVAL_SECONDS", str(24 * 3600)))  # default 24h
 WORKER_QUEUE_PURGE_INTERVAL_SECONDS = int(os.environ.get("WORKER_QUEUE_PURGE_INTERVAL_SECONDS", str(6 * 3600)))  # default 6h (xml_content + raw_body_sample su fatture_queue)
+# Con la sveglia attiva il polling e' solo la rete di sicurezza (sveglia persa,
+# mittente non configurato): puo' essere molto piu' lento dei 15s storici.
+WORKER_WAKEUP_FALLBACK_POLL_SECONDS = int(os.environ.get("WORKER_WAKEUP_FALLBACK_POLL_SECONDS", "60"))
 
 # ─── Assicura PROJECT_ROOT in sys.path ────────────────────────────────────────
 if _ROOT not in sys.path:
@@ -144,6 +153,25 @@ def _ensure_streamlit_available() -> bool:
             return False
 
 
+def _avvia_sveglia():
+    """Avvia il server di sveglia coda se WORKER_WAKEUP_PORT e' impostata.
+
+    Ritorna il CanaleSveglia su cui il loop blocca, oppure None (solo polling,
+    comportamento storico) se la porta non e' configurata o il server non parte.
+    """
+    porta = os.environ.get("WORKER_WAKEUP_PORT", "").strip()
+    if not porta:
+        return None
+    try:
+        from services.queue_wakeup import CanaleSveglia, avvia_server_sveglia
+        canale = CanaleSveglia()
+        avvia_server_sveglia(canale, int(porta), os.environ.get("WORKER_SECRET_KEY", ""))
+        return canale
+    except Exception as exc:
+        logger.warning("Sveglia coda non attiva, resto sul polling: %s", exc)
+        return None
+
+
 def main() -> int:
     logger.info("==== worker fatture_queue - loop continuo ====")
 
@@ -192,20 +220,40 @@ def main() -> int:
     last_retention_time = _boot - WORKER_RETENTION_INTERVAL_SECONDS
     last_queue_purge_time = _boot - WORKER_QUEUE_PURGE_INTERVAL_SECONDS
 
+    # Sveglia event-driven: il loop blocca sul canale invece di dormire e, se
+    # svegliato, serve solo le code interessate. Al timeout (polling di sicurezza)
+    # o senza sveglia le serve entrambe, come sempre.
+    canale = _avvia_sveglia()
+
+    # Le fatture salvate qui invalidano le cache dei processi web (righe, KPI
+    # Home) solo se gli eventi partono: il bus li scrive e legge quelli altrui.
+    try:
+        from services import cache_bus
+        cache_bus.avvia()
+    except Exception as exc:
+        logger.warning("cache_bus non avviato: %s", exc)
+    tutte_le_code = {"fatture", "email"}
+    poll_interval = WORKER_POLL_INTERVAL_SECONDS if canale is None else WORKER_WAKEUP_FALLBACK_POLL_SECONDS
+    da_servire = set(tutte_le_code)
+
     while True:
         cycle_started_at = time.monotonic()
         try:
-            stats = run_cycle()
-            stats.log_summary()
+            stats = None
+            if "fatture" in da_servire:
+                stats = run_cycle()
+                stats.log_summary()
             consecutive_failures = 0
 
             # Ciclo email ricavi (ogni giro del worker, dopo le fatture)
-            if _email_cycle_enabled and run_email_cycle:
+            email_claimed = 0
+            if "email" in da_servire and _email_cycle_enabled and run_email_cycle:
                 try:
                     from worker.queue_processor import get_supabase_client
                     _sb = get_supabase_client()
                     email_stats = run_email_cycle(_sb)
                     email_stats.log_summary()
+                    email_claimed = int(getattr(email_stats, "claimed", 0) or 0)
                 except Exception as email_exc:
                     logger.warning("email-cycle errore: %s", email_exc)
 
@@ -263,18 +311,30 @@ def main() -> int:
 
                 last_retention_time = now
 
-            sleep_seconds = 1 if stats.batch_claimed > 0 else WORKER_POLL_INTERVAL_SECONDS
-            logger.info(
-                "worker sleep=%ss elapsed=%.1fs claimed=%d done=%d retry=%d dead=%d skip=%d",
-                sleep_seconds,
-                time.monotonic() - cycle_started_at,
-                stats.batch_claimed,
-                stats.done,
-                stats.retry_scheduled,
-                stats.dead,
-                stats.skipped,
-            )
-            time.sleep(sleep_seconds)
+            claimed = stats.batch_claimed if stats is not None else 0
+            sleep_seconds = 1 if claimed > 0 or email_claimed > 0 else poll_interval
+            if stats is not None:
+                logger.info(
+                    "worker sleep=%ss elapsed=%.1fs claimed=%d done=%d retry=%d dead=%d skip=%d",
+                    sleep_seconds,
+                    time.monotonic() - cycle_started_at,
+                    stats.batch_claimed,
+                    stats.done,
+                    stats.retry_scheduled,
+                    stats.dead,
+                    stats.skipped,
+                )
+            if canale is None:
+                time.sleep(sleep_seconds)
+                da_servire = set(tutte_le_code)
+            else:
+                da_servire = canale.attendi(sleep_seconds) or set(tutte_le_code)
+                # Una coda che ha appena lavorato puo' avere altro arretrato: la
+                # si ripassa comunque, senza aspettare una nuova sveglia.
+                if claimed > 0:
+                    da_servire.add("fatture")
+                if email_claimed > 0:
+                    da_servire.add("email")
         except KeyboardInterrupt:
             logger.info("Stop richiesto - chiusura pulita")
             return 0